@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import importlib.util
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -40,11 +42,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so it also sees locks raised by the middleware below it
+    'home.middleware.DatabaseLockedMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'home.middleware.CompressionMiddleware',
+    'home.db_router.PrimaryPinMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'home.middleware.ProfilerMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -66,6 +73,21 @@ TEMPLATES = [
     },
 ]
 
+# Optional Jinja2 engine for the bulk-rendered invoice and report pages.
+# Set INVOICE_TEMPLATE_ENGINE = 'jinja2' to render them with it.
+if importlib.util.find_spec('jinja2'):
+    TEMPLATES.append({
+        'BACKEND': 'django.template.backends.jinja2.Jinja2',
+        'NAME': 'jinja2',
+        'DIRS': [],
+        'APP_DIRS': True,
+        'OPTIONS': {
+            'environment': 'home.jinja2env.environment',
+        },
+    })
+
+INVOICE_TEMPLATE_ENGINE = None
+
 WSGI_APPLICATION = 'faisal.wsgi.application'
 
 
@@ -76,9 +98,86 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Write transactions take SQLite's write lock when they begin,
+            # so concurrent edits queue up instead of failing half-way
+            # with "database is locked".
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
+# Reports and exports read from a replica when REPLICA_ENABLED=1. Locally a
+# SQLite snapshot taken with `manage.py refresh_replica` stands in for it.
+REPLICA_ENABLED = os.environ.get('REPLICA_ENABLED', '') == '1'
+REPLICA_SQLITE_PATH = BASE_DIR / 'db_replica.sqlite3'
+if REPLICA_ENABLED:
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': REPLICA_SQLITE_PATH,
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['home.db_router.ReplicaRouter']
+
+# Seconds a client keeps reading from the primary after it writes
+REPLICA_PIN_SECONDS = 60
+# Reads go back to the primary once the snapshot is older than this
+REPLICA_MAX_AGE_SECONDS = 15 * 60
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+# 'default' holds per-process fragments and lookups. 'shared' is seen by
+# every worker process, so sessions and auth lookups stay consistent after
+# a logout or a permission change. Set REDIS_URL (needs the redis package)
+# to back both with Redis instead.
+
+REDIS_URL = os.environ.get('REDIS_URL')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+            'KEY_PREFIX': 'faisal',
+        },
+        'shared': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+            'KEY_PREFIX': 'faisal-shared',
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'faisal-default',
+            'OPTIONS': {'MAX_ENTRIES': 50000},
+        },
+        'shared': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': BASE_DIR / 'cache',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        },
+    }
+
+# Cache for state every worker process must agree on: the generation tokens
+# of per-process tables (see home/utils/generation.py), recent memory profiles
+SHARED_CACHE_ALIAS = 'shared'
+
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+SESSION_CACHE_ALIAS = 'shared'
+
+AUTHENTICATION_BACKENDS = ['home.auth_backends.CachedModelBackend']
+AUTH_CACHE_ALIAS = 'shared'
+AUTH_CACHE_TIMEOUT = 60 * 15
+
+# Runs the suite against in-memory caches, never the ones above
+TEST_RUNNER = 'home.test_runner.TestRunner'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -115,6 +214,61 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+# Fingerprinted, precompressed (.br/.gz) assets in production; plain files
+# while developing so templates work without running collectstatic.
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': (
+            'django.contrib.staticfiles.storage.StaticFilesStorage' if DEBUG
+            else 'home.storage.PrecompressedManifestStaticFilesStorage'
+        ),
+    },
+}
+
+# Paid invoices' final PDFs, stored by content hash (see home/archive.py)
+INVOICE_ARCHIVE_ROOT = BASE_DIR / 'archive'
+
+# Compressed streams and JPEG icons in ReportLab invoice PDFs (see home/utils/pdf.py)
+INVOICE_PDF_COMPACT = True
+
+# Emailing invoice PDFs to customers (see home/mailing.py); each worker
+# keeps one connection to EMAIL_HOST open for the whole run
+DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'billing@localhost')
+INVOICE_EMAIL_WORKERS = 2
+INVOICE_EMAIL_RATE_PER_MINUTE = 120
+INVOICE_EMAIL_QUEUE_SIZE = 8
+# Larger selections go through manage.py email_invoices, not the admin request
+INVOICE_EMAIL_ADMIN_LIMIT = 20
+
+# tracemalloc instrumentation of exports, reports and imports (see
+# home/memprofile.py); results are logged and listed at /memory/
+MEMORY_PROFILING = os.environ.get('MEMORY_PROFILING', '') == '1'
+MEMORY_PROFILE_TOP = 10
+MEMORY_PROFILE_KEEP = 50
+
+# Staff can add ?_profile=1 to any page to sample it (see home/profiling.py);
+# the oldest stored profiles go once they pass the storage limit
+PROFILE_SAMPLE_INTERVAL = 0.001
+PROFILE_STORAGE_LIMIT = 20 * 1024 * 1024
+
+# E-invoice reporting to the tax authorities (see home/einvoice.py); an
+# authority without a URL keeps its submissions queued
+EINVOICE_AUTHORITIES = {
+    'fbr': {'URL': os.environ.get('FBR_API_URL', ''), 'TOKEN': os.environ.get('FBR_API_TOKEN', '')},
+    'pra': {'URL': os.environ.get('PRA_API_URL', ''), 'TOKEN': os.environ.get('PRA_API_TOKEN', '')},
+}
+EINVOICE_BATCH_SIZE = 50
+EINVOICE_CONCURRENCY = 4
+EINVOICE_TIMEOUT = 15
+EINVOICE_LEASE_SECONDS = 5 * 60
+EINVOICE_BACKOFF_SECONDS = 30
+EINVOICE_MAX_BACKOFF_SECONDS = 60 * 60
+EINVOICE_MAX_ATTEMPTS = 12
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -15,8 +15,14 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path
-from home.views import invoice_pdf, invoice_pdf_goods, invoice_pdf_services, bill_report
+from django.conf import settings
+from django.urls import include, path, re_path
+from home.views import (
+    invoice_pdf, invoice_pdf_goods, invoice_pdf_services, bill_report,
+    invoice_archived_pdf, customer_statement, product_lookup,
+    vehicle_lookup, memory_profiles,
+)
+from home.storage import serve_precompressed
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -25,5 +31,16 @@ urlpatterns = [
          invoice_pdf_goods, name="invoice_pdf_goods"),
     path("invoice/<int:pk>/pdf/services/",
          invoice_pdf_services, name="invoice_pdf_services"),
+    path("invoice/<int:pk>/archive/",
+         invoice_archived_pdf, name="invoice_archived_pdf"),
+    path("invoice/<int:pk>/archive/<str:bill_type>/",
+         invoice_archived_pdf, name="invoice_archived_pdf_type"),
     path("billreport/", bill_report, name="bill_report"),
+    path("statement/", customer_statement, name="customer_statement"),
+    path("products/lookup/", product_lookup, name="product_lookup"),
+    path("vehicles/lookup/", vehicle_lookup, name="vehicle_lookup"),
+    path("api/v1/", include("home.api")),
+    path("memory/", memory_profiles, name="memory_profiles"),
+    re_path(rf"^{settings.STATIC_URL.lstrip('/')}(?P<path>.+)$",
+            serve_precompressed, name="static_asset"),
 ]
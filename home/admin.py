@@ -1,13 +1,38 @@
-from django.contrib import admin
-from .models import Customer, Vehicle, Product, Invoice, InvoiceItem, Taxes
-
-from django.utils.html import format_html
-import csv
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.widgets import AutocompleteSelect
+from .models import (
+    Customer, Vehicle, Product, Invoice, InvoiceItem, Taxes, TaxRate,
+    ColdInvoice, ColdInvoiceItem, StaleInvoiceError, ApiToken, EInvoiceSubmission,
+    RequestProfile,
+)
+
+from django.conf import settings
+from django.utils.html import format_html, format_html_join
 from django.http import HttpResponse, HttpResponseRedirect
-from django.urls import path
+from django.urls import path, reverse
+from django.core.exceptions import FieldError, ValidationError
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
 from django.shortcuts import get_object_or_404
 
-from .utils.pdf import generate_invoice_pdf
+from .utils.lazy import LazyCallable
+from .archive import archive_invoice, archive_queryset, discard_archives
+from .coldstore import restore_invoices
+from .db_router import use_replica
+from .einvoice import enqueue
+from .mailing import send_invoices
+from .memprofile import profile_memory
+from .profiling import call_tree
+from .repricing import impact, reprice, stale_items
+from .exports import (
+    INVOICE_COLUMNS, ITEM_COLUMNS, item_queryset, streaming_csv_response, xlsx_response,
+)
+
+# ReportLab loads on first use, not whenever the admin is imported
+generate_invoice_pdf = LazyCallable("home.utils.pdf.generate_invoice_pdf")
+render_invoices_pdf = LazyCallable("home.utils.pdf.render_invoices_pdf")
 
 
 # SPECIAL_CASES = {
@@ -15,16 +40,55 @@ from .utils.pdf import generate_invoice_pdf
 # }
 
 
+class ProductLookupSelect(AutocompleteSelect):
+    """Admin select2 widget fed by the in-process product index."""
+
+    def get_url(self):
+        return reverse("product_lookup")
+
+
+class ChainedVehicleSelect(AutocompleteSelect):
+    """Vehicle select2 that lists the chosen customer's vehicles.
+
+    Typing searches plate numbers across all customers instead, and picking
+    a vehicle that way fills in its customer (see js/vehicle_chain.js).
+    """
+
+    def __init__(self, field, admin_site, customer_field="customer", **kwargs):
+        super().__init__(field, admin_site, **kwargs)
+        self.customer_field = customer_field
+
+    def get_url(self):
+        return reverse("vehicle_lookup")
+
+    def build_attrs(self, base_attrs, extra_attrs=None):
+        attrs = super().build_attrs(base_attrs, extra_attrs=extra_attrs)
+        # Initialised by vehicle_chain.js rather than the admin's autocomplete.js
+        attrs["class"] = attrs["class"].replace("admin-autocomplete", "vehicle-chain")
+        attrs["data-customer-field"] = f"id_{self.customer_field}"
+        return attrs
+
+    @property
+    def media(self):
+        return super().media + forms.Media(js=["js/vehicle_chain.js"])
+
+
 class InvoiceItemInline(admin.TabularInline):
     model = InvoiceItem
     extra = 1
-    exclude = ("description", "tax_amount", "price_incl_tax", "category")
+    exclude = ("description", "tax_rate", "category")
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        # Renders only the selected product, however big the catalogue is
+        if db_field.name == "product":
+            kwargs["widget"] = ProductLookupSelect(db_field, self.admin_site, using=kwargs.get("using"))
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
 
 @admin.register(Customer)
 class CustomerAdmin(admin.ModelAdmin):
-    list_display = ("name", "address", "srtn", "ntn")
-    search_fields = ("name", "address", "srtn", "ntn")
+    list_display = ("name", "address", "srtn", "ntn", "email")
+    search_fields = ("name", "address", "srtn", "ntn", "email")
 
 
 @admin.register(Vehicle)
@@ -34,10 +98,52 @@ class VehicleAdmin(admin.ModelAdmin):
     list_filter = ("make",)
 
 
+def _stale_items_for(queryset):
+    if queryset.model is Taxes:
+        return stale_items(taxes=queryset)
+    return stale_items(products=queryset)
+
+
+def preview_repricing(modeladmin, request, queryset):
+    report = impact(_stale_items_for(queryset))
+    if not report:
+        modeladmin.message_user(request, "All unpaid invoices already use current prices.", messages.INFO)
+        return
+    changes = ", ".join(
+        f"{row['invoice__invoice_no']} {row['change']:+.2f}" for row in report[:20])
+    if len(report) > 20:
+        changes += f" and {len(report) - 20} more"
+    modeladmin.message_user(
+        request,
+        f"{sum(row['items'] for row in report)} items on {len(report)} unpaid invoices would change "
+        f"by {sum(row['change'] for row in report):+.2f} PKR: {changes}.",
+        messages.INFO,
+    )
+
+
+preview_repricing.short_description = "Preview repricing of unpaid invoices"
+
+
+def reprice_unpaid_invoices(modeladmin, request, queryset):
+    repriced, invoices = reprice(_stale_items_for(queryset))
+    modeladmin.message_user(
+        request, f"Repriced {repriced} items on {invoices} unpaid invoices.", messages.SUCCESS)
+
+
+reprice_unpaid_invoices.short_description = "Reprice unpaid invoices"
+
+
+class TaxRateInline(admin.TabularInline):
+    model = TaxRate
+    extra = 1
+
+
 @admin.register(Taxes)
 class TaxAdmin(admin.ModelAdmin):
     list_display = ("name", "rate")
     search_fields = ("name",)
+    inlines = [TaxRateInline]
+    actions = [preview_repricing, reprice_unpaid_invoices]
 
 
 @admin.register(Product)
@@ -45,6 +151,7 @@ class ProductAdmin(admin.ModelAdmin):
     list_display = ("name", "price_excl_tax", "category")
     search_fields = ("name",)
     exclude = ("hs_code",)
+    actions = [preview_repricing, reprice_unpaid_invoices]
 
 
 # --- Actions ---
@@ -59,12 +166,26 @@ def show_invoices_billreport(modeladmin, request, queryset):
 show_invoices_billreport.short_description = "Show selected invoices in Bill Report"
 
 
+@profile_memory()
 def mark_as_paid(modeladmin, request, queryset):
-    queryset.update(status="paid")
+    ids = list(queryset.values_list("id", flat=True))
+    with transaction.atomic():
+        queryset.update(status="paid", version=F("version") + 1)
+        enqueue(ids)
+    # Rendered again on request if the invoice changes or an FBR/PRA number arrives
+    for invoice in archive_queryset().filter(id__in=ids):
+        archive_invoice(invoice)
 
 
 def mark_as_unpaid(modeladmin, request, queryset):
-    queryset.update(status="unpaid")
+    ids = list(queryset.values_list("id", flat=True))
+    queryset.update(status="unpaid", version=F("version") + 1)
+    discard_archives(ids)
+    # Not reported yet, so nothing to report; it is queued again when paid.
+    # Leased rows stay: their request may already have reached the authority,
+    # and its number must be recorded under the same idempotency key.
+    EInvoiceSubmission.objects.filter(
+        invoice_id__in=ids, status="pending", next_attempt_at__lte=timezone.now()).delete()
 
 
 def download_complete_bill(modeladmin, request, queryset):
@@ -121,10 +242,117 @@ def download_pra_bill(modeladmin, request, queryset):
 download_pra_bill.short_description = "Download PRA Bill (Services) for selected invoices"
 
 
+@profile_memory()
+def download_merged_bills(modeladmin, request, queryset):
+    # One file instead of one browser tab per invoice; icons and fonts are
+    # embedded once for the whole batch
+    pdf = render_invoices_pdf(archive_queryset().filter(pk__in=queryset.values("pk")).order_by("id"))
+    response = HttpResponse(pdf, content_type="application/pdf")
+    response["Content-Disposition"] = 'attachment; filename="invoices.pdf"'
+    return response
+
+
+download_merged_bills.short_description = "Download selected Complete Bills as one PDF"
+
+
+@profile_memory()
+def email_invoices(modeladmin, request, queryset):
+    count = queryset.count()
+    if count > settings.INVOICE_EMAIL_ADMIN_LIMIT:
+        modeladmin.message_user(
+            request,
+            f"{count} invoices selected; the admin emails at most {settings.INVOICE_EMAIL_ADMIN_LIMIT} "
+            f"at a time. Send larger batches with: manage.py email_invoices",
+            messages.ERROR,
+        )
+        return
+    counts = send_invoices(queryset)
+    level = messages.WARNING if counts["failed"] or counts["no_address"] else messages.SUCCESS
+    modeladmin.message_user(
+        request,
+        f"Emailed {counts['sent']} invoices in {counts['messages']} messages; "
+        f"{counts['failed']} failed, {counts['no_address']} without a customer email address.",
+        level,
+    )
+
+
+email_invoices.short_description = "Email selected invoices to their customers"
+
+
+# --- Exports ---
+
+@profile_memory()
+@use_replica
+def export_invoices_csv(modeladmin, request, queryset):
+    return streaming_csv_response(queryset, INVOICE_COLUMNS, "invoices.csv")
+
+
+export_invoices_csv.short_description = "Export selected invoices to CSV"
+
+
+@profile_memory()
+@use_replica
+def export_items_csv(modeladmin, request, queryset):
+    return streaming_csv_response(item_queryset(queryset), ITEM_COLUMNS, "invoice_items.csv")
+
+
+export_items_csv.short_description = "Export line items of selected invoices to CSV"
+
+
+def _xlsx_or_message(modeladmin, request, queryset, columns, filename):
+    try:
+        return xlsx_response(queryset, columns, filename)
+    except ImportError:
+        modeladmin.message_user(
+            request, "XLSX export needs the openpyxl package installed.", messages.ERROR)
+
+
+@profile_memory()
+@use_replica
+def export_invoices_xlsx(modeladmin, request, queryset):
+    return _xlsx_or_message(modeladmin, request, queryset, INVOICE_COLUMNS, "invoices.xlsx")
+
+
+export_invoices_xlsx.short_description = "Export selected invoices to Excel"
+
+
+@profile_memory()
+@use_replica
+def export_items_xlsx(modeladmin, request, queryset):
+    return _xlsx_or_message(
+        modeladmin, request, item_queryset(queryset), ITEM_COLUMNS, "invoice_items.xlsx")
+
+
+export_items_xlsx.short_description = "Export line items of selected invoices to Excel"
+
+
+class InvoiceAdminForm(forms.ModelForm):
+    # Version the editor loaded; the save only goes through if it is unchanged
+    seen_version = forms.IntegerField(widget=forms.HiddenInput, required=False)
+
+    class Meta:
+        model = Invoice
+        fields = "__all__"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk:
+            self.fields["seen_version"].initial = self.instance.version
+
+    def clean(self):
+        cleaned_data = super().clean()
+        customer, vehicle = cleaned_data.get("customer"), cleaned_data.get("vehicle")
+        if customer and vehicle and vehicle.customer_id != customer.pk:
+            self.add_error("vehicle", f"{vehicle} does not belong to {customer}.")
+        return cleaned_data
+
+
 @admin.register(Invoice)
 class InvoiceAdmin(admin.ModelAdmin):
+    form = InvoiceAdminForm
     inlines = [InvoiceItemInline]
     date_hierarchy = "date"
+    autocomplete_fields = ("customer",)
 
     list_display = (
         "invoice_no", "customer", "vehicle",
@@ -136,12 +364,55 @@ class InvoiceAdmin(admin.ModelAdmin):
     search_fields = ("invoice_no", "customer__name", "vehicle__number")
     exclude = ("status", "total_excl_tax", "total_tax", "total_incl_tax")
     actions = [mark_as_paid, mark_as_unpaid, show_invoices_billreport,
-               download_complete_bill, download_fbr_bill, download_pra_bill]
+               download_complete_bill, download_fbr_bill, download_pra_bill, download_merged_bills,
+               email_invoices,
+               export_invoices_csv, export_items_csv,
+               export_invoices_xlsx, export_items_xlsx]
 
     def formatted_total(self, obj):
         return format_html("₨ {}", f"{obj.total_incl_tax:.2f}")
     formatted_total.short_description = "Total (PKR)"
 
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == "vehicle":
+            kwargs["widget"] = ChainedVehicleSelect(db_field, self.admin_site, using=kwargs.get("using"))
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+    def save_model(self, request, obj, form, change):
+        if change:
+            obj.save(expected_version=form.cleaned_data.get("seen_version"))
+        else:
+            obj.save()
+
+    def changeform_view(self, request, object_id=None, form_url="", extra_context=None):
+        try:
+            return super().changeform_view(request, object_id, form_url, extra_context)
+        except StaleInvoiceError as exc:
+            # The whole save, items included, was rolled back
+            self.message_user(request, format_html(
+                "{} while you were editing it, so your changes were not saved. "
+                "The current version is shown below; please make your changes again.",
+                str(exc),
+            ), messages.ERROR)
+            return HttpResponseRedirect(request.path)
+
+    def changelist_view(self, request, extra_context=None):
+        # Archived invoices are only looked up when a date filter asks for them
+        date_filters = {k: v for k, v in request.GET.items() if k.startswith("date__")}
+        if request.method == "GET" and date_filters:
+            try:
+                archived = ColdInvoice.objects.filter(**date_filters).count()
+            except (FieldError, ValidationError, ValueError):
+                archived = 0
+            if archived:
+                self.message_user(request, format_html(
+                    '{} archived invoices also match this date range. <a href="{}?{}">View them</a>.',
+                    archived,
+                    reverse("admin:home_coldinvoice_changelist"),
+                    request.GET.urlencode(),
+                ), messages.INFO)
+        return super().changelist_view(request, extra_context)
+
     # SVG icons for reuse
     from django.utils.safestring import mark_safe
     EYE_SVG = mark_safe(
@@ -200,3 +471,144 @@ class InvoiceAdmin(admin.ModelAdmin):
     # def print_invoice(self, request, invoice_id, special_case, *args, **kwargs):
     #     invoice = get_object_or_404(Invoice, pk=invoice_id)
     #     return generate_invoice_pdf(invoice, special_case)
+
+
+# --- Cold storage ---
+
+class ColdInvoiceItemInline(admin.TabularInline):
+    model = ColdInvoiceItem
+    extra = 0
+    exclude = ("description",)
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+def restore_to_active(modeladmin, request, queryset):
+    restored = restore_invoices(queryset)
+    modeladmin.message_user(request, f"Restored {restored} invoices.", messages.SUCCESS)
+
+
+restore_to_active.short_description = "Restore selected invoices to active invoices"
+
+
+@admin.register(ColdInvoice)
+class ColdInvoiceAdmin(admin.ModelAdmin):
+    inlines = [ColdInvoiceItemInline]
+    date_hierarchy = "date"
+    list_display = ("invoice_no", "customer", "vehicle", "date", "status", "total_incl_tax", "archived_at")
+    list_filter = ("status", "date")
+    search_fields = ("invoice_no", "customer__name", "vehicle__number")
+    actions = [restore_to_active]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(ApiToken)
+class ApiTokenAdmin(admin.ModelAdmin):
+    # Tokens are issued with the create_api_token command; delete one to revoke it
+    list_display = ("name", "user", "created_at")
+    search_fields = ("name", "user__username")
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+def retry_submissions(modeladmin, request, queryset):
+    count = queryset.exclude(status="submitted").update(
+        status="pending", attempts=0, next_attempt_at=timezone.now(), last_error="")
+    modeladmin.message_user(request, f"{count} submissions queued to retry.", messages.SUCCESS)
+
+
+retry_submissions.short_description = "Retry selected submissions now"
+
+
+@admin.register(EInvoiceSubmission)
+class EInvoiceSubmissionAdmin(admin.ModelAdmin):
+    list_display = ("invoice", "authority", "status", "authority_invoice_no",
+                    "attempts", "next_attempt_at", "submitted_at")
+    list_filter = ("authority", "status")
+    search_fields = ("invoice__invoice_no", "authority_invoice_no")
+    list_select_related = ("invoice__customer",)
+    actions = [retry_submissions]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+def download_collapsed_stacks(modeladmin, request, queryset):
+    # flamegraph.pl and speedscope add up repeated stacks, so profiles concatenate
+    response = HttpResponse(
+        "".join(queryset.order_by("created_at").values_list("stacks", flat=True)),
+        content_type="text/plain; charset=utf-8",
+    )
+    response["Content-Disposition"] = 'attachment; filename="profiles.folded"'
+    return response
+
+
+download_collapsed_stacks.short_description = "Download collapsed stacks of selected profiles"
+
+
+def _flame_node(node, total):
+    """One call-tree node and, underneath, its callees side by side."""
+    share = node["count"] / total * 100
+    children = format_html_join("", "{}", ((_flame_node(child, node["count"]),) for child in node["children"]))
+    return format_html(
+        '<div style="flex: 0 0 {}%; min-width: 0">'
+        '<div title="{} &mdash; {} samples" style="margin: 0 1px 1px 0; padding: 1px 3px; overflow: hidden; '
+        'white-space: nowrap; text-overflow: ellipsis; font: 11px monospace; background: hsl({}, 80%, 70%)">{}</div>'
+        '<div style="display: flex">{}</div></div>',
+        f"{share:.3f}", node["name"], node["count"], 20 + len(node["name"]) * 7 % 40,
+        node["name"], children,
+    )
+
+
+def _call_tree_lines(node, depth=0):
+    yield f"{'  ' * depth}{node['count']:>6}  {node['name']}"
+    for child in node["children"]:
+        yield from _call_tree_lines(child, depth + 1)
+
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    # Recorded by adding ?_profile=1 to any page as a staff user
+    list_display = ("created_at", "method", "path", "user", "status_code",
+                    "duration_ms", "queries", "samples", "size")
+    list_filter = ("method", "status_code")
+    search_fields = ("path", "query", "user__username")
+    date_hierarchy = "created_at"
+    list_select_related = ("user",)
+    actions = [download_collapsed_stacks]
+    exclude = ("stacks",)
+    readonly_fields = ("flame_graph", "call_tree_text")
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def flame_graph(self, obj):
+        tree = call_tree(obj.stacks)
+        if not tree["count"]:
+            return "No samples: the request finished within one sampling interval."
+        return format_html('<div style="display: flex; width: 100%">{}</div>', _flame_node(tree, tree["count"]))
+    flame_graph.short_description = "Flame graph"
+
+    def call_tree_text(self, obj):
+        return format_html('<pre style="font-size: 11px">{}</pre>', "\n".join(_call_tree_lines(call_tree(obj.stacks))))
+    call_tree_text.short_description = "Call tree"
@@ -0,0 +1,435 @@
+"""Versioned JSON API for POS terminals and the accounting system.
+
+Mounted under /api/v1/. Every response is built from values() rows, never
+from model instances, and every list is keyset paginated on id: the
+``next`` URL carries an opaque cursor holding the last id served, so a
+page costs one indexed range scan however deep the client has paged.
+
+Clients pick the fields they need with ``?fields=`` (and, for invoices,
+``?item_fields=`` or ``?items=0``); only those columns are selected.
+"""
+import base64
+import binascii
+import functools
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.http import JsonResponse
+from django.urls import path
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.views.decorators.csrf import csrf_exempt
+
+from .coldstore import date_range_filter
+from .db_router import use_replica
+from .einvoice import enqueue
+from .memprofile import profile_memory, stage
+from .models import (
+    ApiToken, Customer, Invoice, InvoiceItem, Product, Vehicle, totals_from_items,
+)
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+MAX_BULK = 500
+
+# Public field name -> values() path
+CUSTOMER_FIELDS = {
+    "id": "id", "name": "name", "address": "address", "srtn": "srtn", "ntn": "ntn",
+    "email": "email",
+}
+VEHICLE_FIELDS = {
+    "id": "id", "customer": "customer_id", "make": "make", "number": "number",
+}
+PRODUCT_FIELDS = {
+    "id": "id", "name": "name", "hs_code": "hs_code", "price_excl_tax": "price_excl_tax",
+    "category": "category_id", "category_name": "category__name",
+}
+INVOICE_FIELDS = {
+    "id": "id", "invoice_no": "invoice_no", "date": "date", "status": "status",
+    "customer": "customer_id", "customer_name": "customer__name",
+    "vehicle": "vehicle_id", "vehicle_number": "vehicle__number",
+    "total_excl_tax": "total_excl_tax", "total_tax": "total_tax",
+    "total_incl_tax": "total_incl_tax", "version": "version",
+}
+ITEM_FIELDS = {
+    "id": "id", "product": "product_id", "product_name": "product__name",
+    "description": "description", "qty": "qty", "price_excl_tax": "price_excl_tax",
+    "category": "category_id", "tax_rate": "tax_rate",
+    "tax_amount": "tax_amount", "price_incl_tax": "price_incl_tax",
+}
+
+
+class ApiError(Exception):
+    def __init__(self, status, message, **extra):
+        super().__init__(message)
+        self.status = status
+        self.body = {"error": message, **extra}
+
+
+def _json(data, status=200):
+    return JsonResponse(data, status=status, encoder=DjangoJSONEncoder)
+
+
+def _authenticate(request):
+    """The user behind an ``Authorization: Token <key>`` header, if any."""
+    header = request.headers.get("Authorization", "")
+    scheme, _, key = header.partition(" ")
+    if scheme.lower() not in ("token", "bearer") or not key.strip():
+        return None
+    token = (
+        ApiToken.objects.select_related("user")
+        .filter(key_digest=ApiToken.digest(key.strip()), user__is_active=True)
+        .first()
+    )
+    return token.user if token else None
+
+
+def endpoint(model, methods):
+    """Wrap an API view: authentication, per-method permission, JSON errors.
+
+    ``methods`` maps HTTP method -> permission codename prefix ("view",
+    "add"). Token auth works for every method; a logged-in session only
+    for safe ones, since API views are exempt from CSRF checks.
+    """
+    def decorator(view):
+        @csrf_exempt
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            try:
+                if request.method not in methods:
+                    raise ApiError(405, "Method not allowed.")
+                user = _authenticate(request)
+                if user is None and request.method == "GET":
+                    user = getattr(request, "user", None)
+                if user is None or not user.is_authenticated:
+                    raise ApiError(401, "Authentication required.")
+                request.user = user
+                perm = f"{model._meta.app_label}.{methods[request.method]}_{model._meta.model_name}"
+                if not user.has_perm(perm):
+                    raise ApiError(403, "Permission denied.")
+                return view(request, *args, **kwargs)
+            except ApiError as error:
+                response = _json(error.body, status=error.status)
+                if error.status == 405:
+                    response["Allow"] = ", ".join(methods)
+                return response
+        return wrapper
+    return decorator
+
+
+# --- Projection and pagination ---
+
+def _projection(fields_map, requested):
+    """[(public name, values() path)] for a comma separated ``fields`` value."""
+    if not requested:
+        return list(fields_map.items())
+    names = [name.strip() for name in requested.split(",") if name.strip()]
+    unknown = [name for name in names if name not in fields_map]
+    if unknown:
+        raise ApiError(400, "Unknown fields: " + ", ".join(unknown) + ".")
+    if "id" not in names:
+        names.insert(0, "id")
+    return [(name, fields_map[name]) for name in names]
+
+
+def _rows(queryset, projection):
+    # values() can't alias a path to the name of a model field ("customer"
+    # for customer_id), so rows are renamed here
+    paths = [field_path for _name, field_path in projection]
+    return [
+        {name: row[field_path] for name, field_path in projection}
+        for row in queryset.values(*paths)
+    ]
+
+
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(json.dumps({"id": last_id}).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        last_id = json.loads(base64.urlsafe_b64decode(padded))["id"]
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise ApiError(400, "Invalid cursor.")
+    if not isinstance(last_id, int):
+        raise ApiError(400, "Invalid cursor.")
+    return last_id
+
+
+def _int_param(request, name, default=None):
+    value = request.GET.get(name)
+    if value in (None, ""):
+        return default
+    if not value.isdigit():
+        raise ApiError(400, f"{name} must be a non-negative integer.")
+    return int(value)
+
+
+def _page(request, queryset, projection):
+    """One keyset page of ``queryset`` as {"results": [...], "next": url}."""
+    limit = min(_int_param(request, "limit", DEFAULT_LIMIT) or DEFAULT_LIMIT, MAX_LIMIT)
+    cursor = request.GET.get("cursor")
+    if cursor:
+        queryset = queryset.filter(id__gt=decode_cursor(cursor))
+    # One row more than the page tells whether there is a next page
+    results = _rows(queryset.order_by("id")[:limit + 1], projection)
+    next_url = None
+    if len(results) > limit:
+        results = results[:limit]
+        params = request.GET.copy()
+        params["cursor"] = encode_cursor(results[-1]["id"])
+        next_url = request.build_absolute_uri(f"{request.path}?{params.urlencode()}")
+    return {"results": results, "next": next_url}
+
+
+def _list(request, queryset, fields_map):
+    return _json(_page(request, queryset, _projection(fields_map, request.GET.get("fields"))))
+
+
+# --- Catalogue ---
+
+@endpoint(Customer, {"GET": "view"})
+@use_replica
+def customers(request):
+    return _list(request, Customer.objects.all(), CUSTOMER_FIELDS)
+
+
+@endpoint(Vehicle, {"GET": "view"})
+@use_replica
+def vehicles(request):
+    queryset = Vehicle.objects.all()
+    customer_id = _int_param(request, "customer")
+    if customer_id is not None:
+        queryset = queryset.filter(customer_id=customer_id)
+    return _list(request, queryset, VEHICLE_FIELDS)
+
+
+@endpoint(Product, {"GET": "view"})
+@use_replica
+def products(request):
+    queryset = Product.objects.all()
+    category_id = _int_param(request, "category")
+    if category_id is not None:
+        queryset = queryset.filter(category_id=category_id)
+    return _list(request, queryset, PRODUCT_FIELDS)
+
+
+# --- Invoices ---
+
+def _attach_items(request, invoices):
+    """Nest each invoice's items under "items", read with a single query."""
+    if request.GET.get("items") == "0" or not invoices:
+        return invoices
+    projection = _projection(ITEM_FIELDS, request.GET.get("item_fields"))
+    projection.append(("_invoice", "invoice_id"))
+    by_invoice = {invoice["id"]: invoice for invoice in invoices}
+    for invoice in invoices:
+        invoice["items"] = []
+    items = InvoiceItem.objects.filter(invoice_id__in=by_invoice).order_by("invoice_id", "id")
+    for item in _rows(items, projection):
+        by_invoice[item.pop("_invoice")]["items"].append(item)
+    return invoices
+
+
+def _invoice_filters(request):
+    filters = {}
+    status = request.GET.get("status")
+    if status:
+        filters["status__in"] = status.split(",")
+    for name in ("customer", "vehicle"):
+        value = _int_param(request, name)
+        if value is not None:
+            filters[f"{name}_id"] = value
+    dates = {}
+    for name in ("date_from", "date_to"):
+        value = request.GET.get(name)
+        if value:
+            dates[name] = parse_date(value)
+            if dates[name] is None:
+                raise ApiError(400, f"{name} must be a date (YYYY-MM-DD).")
+    filters.update(date_range_filter(**dates))
+    return filters
+
+
+def _invoice_list(request):
+    queryset = Invoice.objects.filter(**_invoice_filters(request))
+    page = _page(request, queryset, _projection(INVOICE_FIELDS, request.GET.get("fields")))
+    _attach_items(request, page["results"])
+    return _json(page)
+
+
+def _invoice_rows(request, ids):
+    projection = _projection(INVOICE_FIELDS, request.GET.get("fields"))
+    return _attach_items(request, _rows(Invoice.objects.filter(id__in=ids).order_by("id"), projection))
+
+
+@endpoint(Invoice, {"GET": "view", "POST": "add"})
+def invoices(request):
+    """GET: a page of invoices with their items. POST: create invoices in bulk."""
+    if request.method == "POST":
+        return _bulk_create(request)
+    return use_replica(_invoice_list)(request)
+
+
+@endpoint(Invoice, {"GET": "view"})
+@use_replica
+def invoice_detail(request, pk):
+    rows = _invoice_rows(request, [pk])
+    if not rows:
+        raise ApiError(404, "Not found.")
+    return _json(rows[0])
+
+
+# --- Bulk create ---
+
+def _parse_payload(request):
+    try:
+        payload = json.loads(request.body or b"null")
+    except ValueError:
+        raise ApiError(400, "Request body is not valid JSON.")
+    entries = payload.get("invoices") if isinstance(payload, dict) else None
+    if not isinstance(entries, list) or not entries:
+        raise ApiError(400, 'Expected {"invoices": [...]} with at least one invoice.')
+    if len(entries) > MAX_BULK:
+        raise ApiError(400, f"At most {MAX_BULK} invoices per request.")
+    return entries
+
+
+def _ids(entries, key, nested=None):
+    ids = set()
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        rows = entry.get(nested) if nested else [entry]
+        for row in rows if isinstance(rows, list) else []:
+            if isinstance(row, dict) and _is_id(row.get(key)):
+                ids.add(row[key])
+    return ids
+
+
+def _is_id(value):
+    # bool is an int subclass; True would otherwise look up pk 1
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _parse_date(value):
+    if value is None:
+        return timezone.now()
+    parsed = parse_datetime(value) if isinstance(value, str) else None
+    if parsed is None and isinstance(value, str) and parse_date(value):
+        parsed = parse_datetime(f"{value}T00:00:00")
+    if parsed is None:
+        raise ValueError
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def _build_invoice(entry, customers, vehicles, products):
+    """An unsaved Invoice and its items from one payload entry.
+
+    Returns (invoice, items, errors); nothing is queried, the related rows
+    come from the in_bulk maps.
+    """
+    errors = {}
+    if not isinstance(entry, dict):
+        return None, [], {"invoice": "Must be an object."}
+    # Lists and dicts are unhashable, so check types before the map lookups
+    customer_id, vehicle_id = entry.get("customer"), entry.get("vehicle")
+    customer = customers.get(customer_id) if _is_id(customer_id) else None
+    vehicle = vehicles.get(vehicle_id) if _is_id(vehicle_id) else None
+    if customer is None:
+        errors["customer"] = "Unknown customer."
+    if vehicle is None:
+        errors["vehicle"] = "Unknown vehicle."
+    elif customer is not None and vehicle.customer_id != customer.pk:
+        errors["vehicle"] = "This vehicle does not belong to the selected customer."
+    status = entry.get("status", "unpaid")
+    if not isinstance(status, str) or status not in dict(Invoice.STATUS_CHOICES):
+        errors["status"] = "Unknown status."
+    try:
+        date = _parse_date(entry.get("date"))
+    except ValueError:
+        errors["date"] = "Must be an ISO 8601 date or datetime."
+        date = None
+
+    invoice = Invoice(customer=customer, vehicle=vehicle, status=status, date=date)
+    items = []
+    lines = entry.get("items")
+    if not isinstance(lines, list) or not lines:
+        errors["items"] = "At least one item is required."
+        lines = []
+    item_errors = {}
+    for position, line in enumerate(lines):
+        line = line if isinstance(line, dict) else {"product": None, "qty": None}
+        product_id, qty = line.get("product"), line.get("qty", 1)
+        product = products.get(product_id) if _is_id(product_id) else None
+        description = line.get("description")
+        if product is None:
+            item_errors[position] = {"product": "Unknown product."}
+        elif not _is_id(qty) or qty < 1:
+            item_errors[position] = {"qty": "Must be a positive integer."}
+        elif description is not None and not isinstance(description, str):
+            item_errors[position] = {"description": "Must be a string."}
+        else:
+            items.append(InvoiceItem(
+                invoice=invoice, product=product, qty=qty,
+                description=description or None,
+            ))
+    if item_errors:
+        errors["items"] = item_errors
+    return invoice, items, errors
+
+
+@profile_memory()
+def _bulk_create(request):
+    """Create every invoice in the payload, or none of them.
+
+    The whole payload is validated before anything is written; related
+    rows are fetched with one in_bulk() per model. Invoices and items are
+    then inserted with bulk_create and all totals set by one UPDATE.
+    """
+    with stage("validate"):
+        entries = _parse_payload(request)
+        customers = Customer.objects.in_bulk(_ids(entries, "customer"))
+        vehicles = Vehicle.objects.in_bulk(_ids(entries, "vehicle"))
+        products = Product.objects.select_related("category").in_bulk(
+            _ids(entries, "product", nested="items"))
+
+        built, errors = [], {}
+        for position, entry in enumerate(entries):
+            invoice, items, entry_errors = _build_invoice(entry, customers, vehicles, products)
+            if entry_errors:
+                errors[position] = entry_errors
+            built.append((invoice, items))
+    if errors:
+        raise ApiError(400, "Invalid invoices; none were created.", errors=errors)
+
+    with stage("write"), transaction.atomic():
+        numbers = Invoice.allocate_numbers(len(built))
+        for (invoice, items), number in zip(built, numbers):
+            invoice.invoice_no = number
+        created = Invoice.objects.bulk_create([invoice for invoice, _items in built])
+        all_items = []
+        for invoice, items in built:
+            for item in items:
+                item.invoice = invoice
+                item.apply_pricing()
+                all_items.append(item)
+        InvoiceItem.objects.bulk_create(all_items)
+        ids = [invoice.pk for invoice in created]
+        Invoice.objects.filter(id__in=ids).update(**totals_from_items())
+        # bulk_create skips the post_save signal that queues paid invoices
+        enqueue([invoice.pk for invoice in created if invoice.status == "paid"])
+    return _json({"results": _invoice_rows(request, ids)}, status=201)
+
+
+urlpatterns = [
+    path("customers/", customers, name="api_customers"),
+    path("vehicles/", vehicles, name="api_vehicles"),
+    path("products/", products, name="api_products"),
+    path("invoices/", invoices, name="api_invoices"),
+    path("invoices/<int:pk>/", invoice_detail, name="api_invoice_detail"),
+]
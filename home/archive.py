@@ -0,0 +1,123 @@
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.db.models import Prefetch
+
+from .models import ArchivedPdf, Invoice, InvoiceItem
+from .utils.lazy import LazyCallable
+
+render_invoice_pdf = LazyCallable("home.utils.pdf.render_invoice_pdf")
+
+# Bill type -> prefix generate_invoice_pdf prints before the invoice number
+BILL_TYPE_PREFIXES = {
+    "complete": "",
+    "goods": "F-",
+    "services": "P-",
+}
+
+
+def archive_path(sha256):
+    return os.path.join(
+        settings.INVOICE_ARCHIVE_ROOT, sha256[:2], sha256[2:4], f"{sha256}.pdf")
+
+
+def store_pdf(data):
+    """Write PDF bytes under their content hash and return (sha256, size).
+
+    Identical documents map to the same file, so a second copy is never
+    written. New files are written to a temp name and renamed into place,
+    so readers never see a half-written PDF.
+    """
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = archive_path(sha256)
+    if not os.path.exists(path):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return sha256, len(data)
+
+
+def bill_types_for(invoice):
+    bill_types = ["complete"]
+    if invoice.has_goods():
+        bill_types.append("goods")
+    if invoice.has_services():
+        bill_types.append("services")
+    return bill_types
+
+
+def render_archives(invoice):
+    """Render every bill type of an invoice and store the PDFs.
+
+    Returns a list of (bill_type, sha256, size) tuples.
+    """
+    results = []
+    for bill_type in bill_types_for(invoice):
+        pdf = render_invoice_pdf(
+            invoice, BILL_TYPE_PREFIXES[bill_type], invariant=True)
+        results.append((bill_type, *store_pdf(pdf)))
+    return results
+
+
+def archive_invoice(invoice):
+    """Archive the final PDFs of a paid invoice, skipping bill types already stored."""
+    existing = set(invoice.archived_pdfs.values_list("bill_type", flat=True))
+    records = []
+    for bill_type in bill_types_for(invoice):
+        if bill_type in existing:
+            continue
+        pdf = render_invoice_pdf(
+            invoice, BILL_TYPE_PREFIXES[bill_type], invariant=True)
+        sha256, size = store_pdf(pdf)
+        record, _ = ArchivedPdf.objects.get_or_create(
+            invoice=invoice, bill_type=bill_type,
+            defaults={"sha256": sha256, "size": size},
+        )
+        records.append(record)
+    return records
+
+
+def discard_archives(invoice_ids):
+    """Forget the archived PDFs of invoices whose content changed.
+
+    They are rendered again on the next request for them. Files stay on
+    disk: other invoices may share the same content hash.
+    """
+    ArchivedPdf.objects.filter(invoice_id__in=invoice_ids).delete()
+
+
+def archive_queryset():
+    """Invoices with everything render_invoice_pdf touches prefetched."""
+    return Invoice.objects.select_related("customer", "vehicle").prefetch_related(
+        Prefetch("items", queryset=InvoiceItem.objects.select_related(
+            "product", "category")),
+    )
+
+
+def render_archive_batch(invoice_ids):
+    """Worker entry point for the backfill: render and store, no DB writes.
+
+    Returns (invoice_id, bill_type, sha256, size) tuples for the parent
+    process to record.
+    """
+    rows = []
+    for invoice in archive_queryset().filter(id__in=invoice_ids):
+        for bill_type, sha256, size in render_archives(invoice):
+            rows.append((invoice.id, bill_type, sha256, size))
+    return rows
+
+
+def record_archives(rows):
+    ArchivedPdf.objects.bulk_create(
+        [
+            ArchivedPdf(invoice_id=invoice_id, bill_type=bill_type,
+                        sha256=sha256, size=size)
+            for invoice_id, bill_type, sha256, size in rows
+        ],
+        ignore_conflicts=True,
+    )
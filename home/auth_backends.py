@@ -0,0 +1,103 @@
+"""ModelBackend that keeps users and their permissions in the shared cache.
+
+Every admin request loads the logged-in user and checks permissions for
+each app and model on the page. Those rows almost never change, so they
+are served from the cache named by AUTH_CACHE_ALIAS. Saving or deleting
+a user drops that user's entry. The password hash is never cached: a
+user comes back with it deferred, and the two things each admin page
+derives from it (the session hash and has_usable_password()) are cached
+beside the other fields. Any change to group membership or to
+group and user permissions bumps a generation token that invalidates
+every cached permission set.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import Group, Permission
+from django.core.cache import caches
+from django.db import router
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .utils import generation as tokens
+
+GENERATION_KEY = "auth:generation"
+
+User = get_user_model()
+
+
+def auth_cache():
+    return caches[settings.AUTH_CACHE_ALIAS]
+
+
+def generation():
+    return tokens.current(GENERATION_KEY, auth_cache())
+
+
+def bump_generation():
+    tokens.bump(GENERATION_KEY, auth_cache())
+
+
+def user_key(user_id):
+    return f"auth:user:{user_id}"
+
+
+def permissions_key(kind, user_obj, gen=None):
+    return f"auth:perms:{kind}:{user_obj.pk}:{gen or generation()}"
+
+
+def _cached_fields():
+    return [field.attname for field in User._meta.concrete_fields if field.name != "password"]
+
+
+class CachedModelBackend(ModelBackend):
+    def get_user(self, user_id):
+        cache = auth_cache()
+        cached = cache.get(user_key(user_id))
+        if cached is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                values = [getattr(user, attname) for attname in _cached_fields()]
+                cache.set(user_key(user_id),
+                          (values, user.get_session_auth_hash(), user.has_usable_password()),
+                          settings.AUTH_CACHE_TIMEOUT)
+            return user
+        values, session_hash, usable_password = cached
+        user = User.from_db(router.db_for_read(User), _cached_fields(), values)
+        # The session check and the admin header would otherwise load the deferred password
+        user.get_session_auth_hash = lambda: session_hash
+        user.has_usable_password = lambda: usable_password
+        return user
+
+    def _cached_permissions(self, kind, user_obj, obj, compute):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return compute(user_obj, obj=obj)
+        key = permissions_key(kind, user_obj)
+        perms = auth_cache().get(key)
+        if perms is None:
+            perms = compute(user_obj, obj=obj)
+            auth_cache().set(key, perms, settings.AUTH_CACHE_TIMEOUT)
+        return perms
+
+    def get_user_permissions(self, user_obj, obj=None):
+        return self._cached_permissions(
+            "user", user_obj, obj, super().get_user_permissions)
+
+    def get_group_permissions(self, user_obj, obj=None):
+        return self._cached_permissions(
+            "group", user_obj, obj, super().get_group_permissions)
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    auth_cache().delete(user_key(instance.pk))
+
+
+@receiver([post_save, post_delete], sender=Group)
+@receiver([post_save, post_delete], sender=Permission)
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_cached_permissions(sender, **kwargs):
+    if kwargs.get("action", "post_").startswith("post_"):
+        bump_generation()
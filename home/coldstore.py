@@ -0,0 +1,93 @@
+"""Move closed invoices out of the hot Invoice/InvoiceItem tables and back.
+
+Cold rows keep their original primary keys and invoice numbers, so a
+restored invoice is indistinguishable from one that never left. E-invoice
+outbox rows are not kept in cold storage: an invoice leaves only once no
+row of it can still be sent or needs attention, and a restored invoice
+gets fresh rows for whichever authority has not numbered it.
+"""
+import datetime
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .einvoice import configured_authorities, enqueue_unnumbered
+from .models import ColdInvoice, ColdInvoiceItem, EInvoiceSubmission, Invoice, InvoiceItem
+
+CLOSED_STATUSES = ("paid",)
+
+INVOICE_FIELDS = [
+    "id", "invoice_no", "date", "customer_id", "vehicle_id", "status",
+    "total_excl_tax", "total_tax", "total_incl_tax", "version",
+    "fbr_invoice_no", "pra_invoice_no", "email_status", "emailed_at",
+]
+ITEM_FIELDS = [
+    "id", "invoice_id", "product_id", "description", "qty",
+    "price_excl_tax", "category_id", "tax_rate",
+]
+
+
+def _move_batch(ids, source_invoice, source_item, target_invoice, target_item):
+    with transaction.atomic():
+        target_invoice.objects.bulk_create([
+            target_invoice(**row)
+            for row in source_invoice.objects.filter(id__in=ids).values(*INVOICE_FIELDS)
+        ])
+        items = source_item.objects.filter(invoice_id__in=ids)
+        target_item.objects.bulk_create([
+            target_item(**row) for row in items.values(*ITEM_FIELDS)
+        ])
+        # Raw delete skips the InvoiceItem post_delete signal, which would
+        # otherwise recompute totals of an invoice that is about to go away.
+        items._raw_delete(items.db)
+        # Also deletes the hot invoices' outbox rows
+        source_invoice.objects.filter(id__in=ids).delete()
+        if target_invoice is Invoice:
+            enqueue_unnumbered(ids)
+
+
+def _move(queryset, batch_size, *models):
+    moved = 0
+    while True:
+        ids = list(queryset.order_by("id").values_list("id", flat=True)[:batch_size])
+        if not ids:
+            return moved
+        _move_batch(ids, *models)
+        moved += len(ids)
+
+
+def archive_invoices(before, statuses=CLOSED_STATUSES, batch_size=500):
+    """Move closed invoices dated before ``before`` (a date) to cold storage.
+
+    Each batch is its own transaction, so writers are never locked out for
+    the whole run and an interrupted run keeps what it has moved.
+    """
+    cutoff = timezone.make_aware(datetime.datetime.combine(before, datetime.time.min))
+    # Invoices still waiting for a tax authority number stay until they get
+    # one, and rejected ones stay in front of staff. A row that was never
+    # sent, because its authority is not configured, is written again on
+    # restore; one that was sent must keep its idempotency key.
+    unsettled = EInvoiceSubmission.objects.filter(
+        Q(status="failed")
+        | Q(status="pending") & (Q(authority__in=configured_authorities()) | Q(attempts__gt=0))
+    ).values("invoice_id")
+    queryset = Invoice.objects.filter(date__lt=cutoff, status__in=statuses).exclude(id__in=unsettled)
+    return _move(queryset, batch_size, Invoice, InvoiceItem, ColdInvoice, ColdInvoiceItem)
+
+
+def restore_invoices(queryset, batch_size=500):
+    """Move the given ColdInvoice rows back into the working set."""
+    return _move(queryset, batch_size, ColdInvoice, ColdInvoiceItem, Invoice, InvoiceItem)
+
+
+def date_range_filter(date_from=None, date_to=None):
+    """Filter kwargs for invoices dated within [date_from, date_to] (dates)."""
+    filters = {}
+    if date_from:
+        filters["date__gte"] = timezone.make_aware(
+            datetime.datetime.combine(date_from, datetime.time.min))
+    if date_to:
+        filters["date__lt"] = timezone.make_aware(
+            datetime.datetime.combine(date_to + datetime.timedelta(days=1), datetime.time.min))
+    return filters
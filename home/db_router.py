@@ -0,0 +1,92 @@
+"""Send report and export reads to a read replica, everything else to primary.
+
+Reads only go to the replica inside a ``use_replica`` view or action, and
+never once the client has written: a write pins the rest of the request,
+and a short-lived cookie pins the client's following requests, so users
+always read their own writes. A replica snapshot older than
+REPLICA_MAX_AGE_SECONDS is not read at all.
+"""
+import functools
+import os
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+
+REPLICA = "replica"
+PIN_COOKIE = "pin_primary"
+
+_replica_reads = ContextVar("replica_reads", default=False)
+_pinned = ContextVar("pinned", default=False)
+_wrote = ContextVar("wrote", default=False)
+
+# Writes to these apps don't pin: session saves would otherwise pin every request
+UNPINNED_APPS = {"sessions"}
+
+
+def replica_available():
+    """Whether the replica is configured and its snapshot is recent enough to read."""
+    if REPLICA not in settings.DATABASES:
+        return False
+    try:
+        # refresh_replica stamps the snapshot with the time it was taken
+        taken = os.stat(settings.REPLICA_SQLITE_PATH).st_mtime
+    except OSError:
+        return False
+    return time.time() - taken <= settings.REPLICA_MAX_AGE_SECONDS
+
+
+def use_replica(func):
+    """Allow the wrapped view or admin action to read from the replica."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # Checked once per call, not on every query it runs
+        token = _replica_reads.set(replica_available())
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _replica_reads.reset(token)
+    return wrapper
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _replica_reads.get() and not _pinned.get():
+            return REPLICA
+        return "default"
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label not in UNPINNED_APPS:
+            _pinned.set(True)
+            _wrote.set(True)
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica is a copy of default, never migrated on its own
+        return db == "default"
+
+
+class PrimaryPinMiddleware:
+    """Keep a client on the primary for a while after it writes."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        pinned = _pinned.set(PIN_COOKIE in request.COOKIES)
+        wrote = _wrote.set(False)
+        try:
+            response = self.get_response(request)
+            if _wrote.get():
+                response.set_cookie(
+                    PIN_COOKIE, "1",
+                    max_age=getattr(settings, "REPLICA_PIN_SECONDS", 60),
+                    httponly=True, samesite="Lax",
+                )
+            return response
+        finally:
+            _pinned.reset(pinned)
+            _wrote.reset(wrote)
@@ -0,0 +1,278 @@
+"""Report paid invoices to FBR (goods) and PRA (services).
+
+Marking an invoice paid writes one EInvoiceSubmission per authority in
+the same transaction (a transactional outbox), so the counter never
+waits on the authorities' APIs and a crash can't lose a report. The
+submit_einvoices worker then:
+
+* claims due rows by pushing their next_attempt_at forward (a lease), so
+  several workers never send the same row at once;
+* builds each payload from values() rows and posts them in batches of
+  EINVOICE_BATCH_SIZE, at most EINVOICE_CONCURRENCY requests in flight;
+* writes the returned numbers back to the invoice, and reschedules rows
+  whose batch failed with exponential backoff and jitter.
+
+Every row carries an idempotency key, so a retry after a lost response
+gets the number already issued rather than a second one.
+"""
+import hashlib
+import json
+import logging
+import random
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .archive import discard_archives
+from .models import EInvoiceSubmission, Invoice, InvoiceItem
+
+logger = logging.getLogger(__name__)
+
+# Authority -> item category it reports, and the invoice field for its number
+AUTHORITIES = {
+    "fbr": ("goods", "fbr_invoice_no"),
+    "pra": ("service", "pra_invoice_no"),
+}
+# Whole-batch responses worth retrying (a bad token is fixed by
+# configuration, not by the invoice); anything else rejects the batch
+RETRY_STATUSES = {401, 403, 408, 409, 425, 429, 500, 502, 503, 504}
+
+
+def configured_authorities():
+    """Authorities with an API URL; rows for the others just wait."""
+    return [name for name in AUTHORITIES if settings.EINVOICE_AUTHORITIES.get(name, {}).get("URL")]
+
+
+def enqueue(invoice_ids):
+    """Add outbox rows for the given paid invoices; existing rows are kept."""
+    EInvoiceSubmission.objects.bulk_create(
+        [
+            EInvoiceSubmission(invoice_id=invoice_id, authority=authority,
+                               idempotency_key=uuid.uuid4().hex)
+            for invoice_id in invoice_ids
+            for authority in AUTHORITIES
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def enqueue_unnumbered(invoice_ids):
+    """Add outbox rows for the authorities that have not numbered these paid invoices yet."""
+    fields = {authority: field for authority, (_category, field) in AUTHORITIES.items()}
+    rows = Invoice.objects.filter(id__in=invoice_ids, status="paid").values("id", *fields.values())
+    EInvoiceSubmission.objects.bulk_create(
+        [
+            EInvoiceSubmission(invoice_id=row["id"], authority=authority,
+                               idempotency_key=uuid.uuid4().hex)
+            for row in rows
+            for authority, field in fields.items()
+            if not row[field]
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def backoff(attempts):
+    """Seconds to wait after the ``attempts``-th failure: doubling, capped, jittered."""
+    delay = min(settings.EINVOICE_BACKOFF_SECONDS * 2 ** (attempts - 1),
+                settings.EINVOICE_MAX_BACKOFF_SECONDS)
+    return delay * random.uniform(0.5, 1.0)
+
+
+# --- Claiming ---
+
+def claim(authority, limit, now=None):
+    """Lease up to ``limit`` due rows of ``authority``; returns their ids."""
+    now = now or timezone.now()
+    with transaction.atomic():
+        due = EInvoiceSubmission.objects.filter(
+            authority=authority, status="pending", next_attempt_at__lte=now,
+        ).order_by("next_attempt_at", "id")
+        if connection.features.has_select_for_update_skip_locked:
+            due = due.select_for_update(skip_locked=True)
+        ids = list(due.values_list("id", flat=True)[:limit])
+        EInvoiceSubmission.objects.filter(id__in=ids).update(
+            attempts=F("attempts") + 1,
+            next_attempt_at=now + timedelta(seconds=settings.EINVOICE_LEASE_SECONDS),
+        )
+    return ids
+
+
+# --- Payloads ---
+
+def _cents(value):
+    return value.quantize(Decimal("0.01"))
+
+
+def build_payloads(submission_ids):
+    """{submission_id: payload}; rows with nothing to report map to None."""
+    submissions = list(
+        EInvoiceSubmission.objects.filter(id__in=submission_ids).values(
+            "id", "authority", "idempotency_key", "invoice_id",
+            "invoice__invoice_no", "invoice__date",
+            "invoice__customer__name", "invoice__customer__ntn", "invoice__customer__srtn",
+        )
+    )
+    invoice_ids = {row["invoice_id"] for row in submissions}
+    items = {}
+    for item in (
+        InvoiceItem.objects.filter(invoice_id__in=invoice_ids)
+        .order_by("invoice_id", "id")
+        .values("invoice_id", "product__name", "product__hs_code", "category__name",
+                "qty", "price_excl_tax", "tax_rate", "tax_amount", "price_incl_tax")
+    ):
+        category = (item["category__name"] or "").lower()
+        items.setdefault((item["invoice_id"], category), []).append({
+            "name": item["product__name"],
+            "hs_code": item["product__hs_code"] or "",
+            "qty": item["qty"],
+            "rate": item["tax_rate"],
+            "sale_value": _cents(item["price_excl_tax"] * item["qty"]),
+            "tax": _cents(item["tax_amount"]),
+            "total": _cents(item["price_incl_tax"]),
+        })
+
+    payloads = {}
+    for row in submissions:
+        category, _field = AUTHORITIES[row["authority"]]
+        lines = items.get((row["invoice_id"], category))
+        if not lines:
+            payloads[row["id"]] = None
+            continue
+        payloads[row["id"]] = {
+            "idempotency_key": row["idempotency_key"],
+            "invoice_no": row["invoice__invoice_no"],
+            "date": row["invoice__date"],
+            "buyer_name": row["invoice__customer__name"],
+            "buyer_ntn": row["invoice__customer__ntn"] or "",
+            "buyer_srtn": row["invoice__customer__srtn"] or "",
+            "items": lines,
+            "total_qty": sum(line["qty"] for line in lines),
+            "total_sale_value": sum(line["sale_value"] for line in lines),
+            "total_tax": sum(line["tax"] for line in lines),
+            "total_amount": sum(line["total"] for line in lines),
+        }
+    return payloads
+
+
+# --- Transport (runs in worker threads; no database access) ---
+
+def post_batch(authority, payloads):
+    """POST one batch; returns ("ok", {key: result}) or ("retry"/"reject", reason, retry_after)."""
+    config = settings.EINVOICE_AUTHORITIES[authority]
+    keys = sorted(payload["idempotency_key"] for payload in payloads)
+    body = json.dumps({"invoices": payloads}, cls=DjangoJSONEncoder).encode()
+    request = urllib.request.Request(config["URL"], data=body, method="POST", headers={
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {config.get('TOKEN', '')}",
+        # The same batch retried is the same request
+        "Idempotency-Key": hashlib.sha256("".join(keys).encode()).hexdigest()[:32],
+    })
+    try:
+        with urllib.request.urlopen(request, timeout=settings.EINVOICE_TIMEOUT) as response:
+            results = json.load(response)["results"]
+    except urllib.error.HTTPError as error:
+        retry_after = error.headers.get("Retry-After", "")
+        reason = f"HTTP {error.code}: {error.read()[:500].decode(errors='replace')}"
+        outcome = "retry" if error.code in RETRY_STATUSES else "reject"
+        return outcome, reason, int(retry_after) if retry_after.isdigit() else 0
+    except (OSError, ValueError, KeyError, TypeError) as error:
+        return "retry", f"{type(error).__name__}: {error}", 0
+    return "ok", {result.get("idempotency_key"): result for result in results}
+
+
+# --- Recording outcomes ---
+
+def _retry(submission_ids, reason, now, retry_after=0):
+    retrying = failed = 0
+    rows = EInvoiceSubmission.objects.filter(id__in=submission_ids).values_list("id", "attempts")
+    for submission_id, attempts in rows:
+        if attempts >= settings.EINVOICE_MAX_ATTEMPTS:
+            EInvoiceSubmission.objects.filter(id=submission_id).update(status="failed", last_error=reason)
+            failed += 1
+        else:
+            delay = max(backoff(attempts), retry_after)
+            EInvoiceSubmission.objects.filter(id=submission_id).update(
+                last_error=reason, next_attempt_at=now + timedelta(seconds=delay))
+            retrying += 1
+    return retrying, failed
+
+
+def _record(authority, batch, outcome, now, counts):
+    ids = [submission_id for submission_id, _payload in batch]
+    if outcome[0] == "retry":
+        retrying, failed = _retry(ids, outcome[1], now, outcome[2])
+        counts["retrying"] += retrying
+        counts["failed"] += failed
+        return
+    if outcome[0] == "reject":
+        EInvoiceSubmission.objects.filter(id__in=ids).update(status="failed", last_error=outcome[1])
+        counts["failed"] += len(ids)
+        return
+
+    _category, number_field = AUTHORITIES[authority]
+    results = outcome[1]
+    missing = []
+    numbered = []
+    with transaction.atomic():
+        for submission_id, payload in batch:
+            result = results.get(payload["idempotency_key"])
+            if result is None:
+                missing.append(submission_id)
+            elif result.get("invoice_number"):
+                EInvoiceSubmission.objects.filter(id=submission_id).update(
+                    status="submitted", authority_invoice_no=result["invoice_number"],
+                    submitted_at=now, last_error="")
+                # version bump: cached fragments show the new number
+                Invoice.objects.filter(invoice_no=payload["invoice_no"]).update(
+                    **{number_field: result["invoice_number"]}, version=F("version") + 1)
+                numbered.append(payload["invoice_no"])
+                counts["submitted"] += 1
+            else:
+                EInvoiceSubmission.objects.filter(id=submission_id).update(
+                    status="failed", last_error=str(result.get("error") or "Rejected."))
+                counts["failed"] += 1
+    # Archived PDFs were rendered without the number and its QR code
+    discard_archives(Invoice.objects.filter(invoice_no__in=numbered).values("pk"))
+    if missing:
+        retrying, failed = _retry(missing, "No result for this invoice in the response.", now)
+        counts["retrying"] += retrying
+        counts["failed"] += failed
+
+
+def submit_due(authorities=None, now=None):
+    """Send every due outbox row once; returns counts by outcome."""
+    counts = {"submitted": 0, "not_required": 0, "retrying": 0, "failed": 0}
+    batch_size = settings.EINVOICE_BATCH_SIZE
+    concurrency = settings.EINVOICE_CONCURRENCY
+    for authority in authorities or AUTHORITIES:
+        if authority not in configured_authorities():
+            logger.warning("No URL configured for %s; its submissions stay queued.", authority)
+            continue
+        while True:
+            ids = claim(authority, batch_size * concurrency, now)
+            if not ids:
+                break
+            payloads = build_payloads(ids)
+            empty = [submission_id for submission_id, payload in payloads.items() if payload is None]
+            EInvoiceSubmission.objects.filter(id__in=empty).update(status="not_required")
+            counts["not_required"] += len(empty)
+
+            ready = sorted((submission_id, payload) for submission_id, payload in payloads.items()
+                           if payload is not None)
+            batches = [ready[start:start + batch_size] for start in range(0, len(ready), batch_size)]
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                outcomes = pool.map(
+                    lambda batch: post_batch(authority, [payload for _id, payload in batch]), batches)
+                for batch, outcome in zip(batches, outcomes):
+                    _record(authority, batch, outcome, now or timezone.now(), counts)
+    return counts
@@ -0,0 +1,110 @@
+"""A local stand-in for the FBR and PRA e-invoicing APIs.
+
+Accepts the batches home/einvoice.py sends on /fbr/ and /pra/ and issues
+numbers like "FBR-000001", once per idempotency key. Tests use it to
+inject failures (``fail_next``), reject invoices (``reject``), slow
+responses down (``delay``) and check how many requests were in flight at
+once (``max_in_flight``). ``manage.py run_einvoice_stub`` serves it for
+local development.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubAuthority:
+    def __init__(self, host="127.0.0.1", port=0, delay=0.0):
+        self.delay = delay
+        self.reject = set()          # invoice numbers to refuse
+        self.issued = {}             # (authority, idempotency key) -> number
+        self.requests = []           # (authority, invoice count) per request
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._failures = []          # HTTP statuses for the next requests
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def fail_next(self, count, status=503):
+        with self._lock:
+            self._failures.extend([status] * count)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def handle(self, authority, payload):
+        """(status, body) for one batch."""
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            failure = self._failures.pop(0) if self._failures else None
+        try:
+            if self.delay:
+                time.sleep(self.delay)
+            if failure:
+                return failure, {"error": "Service unavailable."}
+            invoices = payload.get("invoices") or []
+            results = []
+            with self._lock:
+                self.requests.append((authority, len(invoices)))
+                for invoice in invoices:
+                    key = invoice["idempotency_key"]
+                    if invoice.get("invoice_no") in self.reject:
+                        results.append({"idempotency_key": key, "error": "Invalid buyer NTN."})
+                        continue
+                    number = self.issued.get((authority, key))
+                    if number is None:
+                        count = sum(1 for issuer, _key in self.issued if issuer == authority)
+                        number = f"{authority.upper()}-{count + 1:06d}"
+                        self.issued[(authority, key)] = number
+                    results.append({"idempotency_key": key, "invoice_number": number})
+            return 200, {"results": results}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                authority = self.path.strip("/").split("/")[0]
+                if authority not in ("fbr", "pra"):
+                    return self._send(404, {"error": "Unknown authority."})
+                try:
+                    payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                except ValueError:
+                    return self._send(400, {"error": "Invalid JSON."})
+                self._send(*stub.handle(authority, payload))
+
+            def _send(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
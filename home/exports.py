@@ -0,0 +1,110 @@
+import csv
+import tempfile
+
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+
+from .models import InvoiceItem
+
+CHUNK_SIZE = 2000
+ROWS_PER_WRITE = 500
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+# (header, values() field) pairs for each export flavour
+INVOICE_COLUMNS = [
+    ("Invoice No", "invoice_no"),
+    ("Date", "date"),
+    ("Customer", "customer__name"),
+    ("Vehicle", "vehicle__number"),
+    ("Status", "status"),
+    ("Total Excl Tax (PKR)", "total_excl_tax"),
+    ("Total Tax (PKR)", "total_tax"),
+    ("Total Incl Tax (PKR)", "total_incl_tax"),
+]
+
+ITEM_COLUMNS = [
+    ("Invoice No", "invoice__invoice_no"),
+    ("Date", "invoice__date"),
+    ("Customer", "invoice__customer__name"),
+    ("Vehicle", "invoice__vehicle__number"),
+    ("Product", "product__name"),
+    ("Category", "category__name"),
+    ("Qty", "qty"),
+    ("Unit Price Excl Tax (PKR)", "price_excl_tax"),
+    ("Tax Amount (PKR)", "tax_amount"),
+    ("Total Incl Tax (PKR)", "price_incl_tax"),
+]
+
+
+class Echo:
+    """File-like object whose write() hands the line back instead of storing it."""
+
+    def write(self, value):
+        return value
+
+
+def _format(value):
+    if hasattr(value, "tzinfo"):
+        return timezone.localtime(value).strftime("%Y-%m-%d %H:%M")
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        # Spreadsheets would run "=HYPERLINK(...)" in a customer name as a formula
+        return "'" + value
+    return value
+
+
+def export_rows(queryset, columns):
+    """Yield export rows from a values_list projection, chunk by chunk."""
+    fields = [field for _header, field in columns]
+    rows = queryset.order_by("pk").values_list(*fields).iterator(chunk_size=CHUNK_SIZE)
+    for row in rows:
+        yield [_format(value) for value in row]
+
+
+def item_queryset(invoice_queryset):
+    return InvoiceItem.objects.filter(invoice__in=invoice_queryset.values("pk"))
+
+
+def _csv_lines(queryset, columns):
+    writer = csv.writer(Echo())
+    buffer = [writer.writerow([header for header, _field in columns])]
+    for row in export_rows(queryset, columns):
+        buffer.append(writer.writerow(row))
+        if len(buffer) >= ROWS_PER_WRITE:
+            yield "".join(buffer)
+            buffer = []
+    if buffer:
+        yield "".join(buffer)
+
+
+def streaming_csv_response(queryset, columns, filename):
+    """CSV download that starts sending immediately and never holds all rows."""
+    # Rows are read after the view returns, so fix the database chosen now
+    queryset = queryset.using(queryset.db)
+    response = StreamingHttpResponse(_csv_lines(queryset, columns), content_type="text/csv")
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+def xlsx_response(queryset, columns, filename):
+    """XLSX download built with openpyxl's write-only workbook.
+
+    The workbook is spooled to a temporary file rather than memory, since
+    the zip container can only be sent once it is complete.
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append([header for header, _field in columns])
+    for row in export_rows(queryset, columns):
+        sheet.append(row)
+
+    spool = tempfile.TemporaryFile()
+    workbook.save(spool)
+    spool.seek(0)
+    return FileResponse(
+        spool,
+        as_attachment=True,
+        filename=filename,
+        content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    )
@@ -0,0 +1,83 @@
+"""Cached HTML fragments for invoices, keyed on the invoice version.
+
+A fragment key combines the invoice's id and version with a catalogue
+generation. Editing an invoice, or a vehicle or product it shows, bumps
+its version, so only that invoice's fragments go stale. Editing a tax
+bumps the generation, which invalidates every fragment at once. Fragments are
+cached per process, but the generation lives in the shared cache so an
+edit in one worker reaches all of them.
+"""
+from django.core.cache import cache
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .utils import generation as tokens
+
+FRAGMENT_TIMEOUT = 60 * 60 * 24 * 7
+GENERATION_KEY = "fragments:generation"
+
+
+def generation():
+    return tokens.current(GENERATION_KEY)
+
+
+def bump_generation():
+    # After the commit, so no worker re-renders the old rows under the new token
+    transaction.on_commit(lambda: tokens.bump(GENERATION_KEY))
+
+
+def fragment_key(kind, invoice, gen=None):
+    return "fragment:{}:{}:{}:{}:{}".format(
+        kind, invoice._meta.model_name, invoice.pk,
+        getattr(invoice, "version", 0), gen or generation(),
+    )
+
+
+def _category_flags(invoices):
+    """{(model_name, pk): (has_goods, has_services)} in one query per model."""
+    by_model = {}
+    for invoice in invoices:
+        by_model.setdefault(invoice._meta.model, []).append(invoice.pk)
+
+    flags = {}
+    for model, ids in by_model.items():
+        item_model = model._meta.get_field("items").related_model
+        rows = (
+            item_model.objects.filter(invoice_id__in=ids)
+            .values_list("invoice_id", "product__category__name")
+            .distinct()
+        )
+        for invoice_id, category in rows:
+            key = (model._meta.model_name, invoice_id)
+            goods, services = flags.get(key, (False, False))
+            category = (category or "").lower()
+            flags[key] = (goods or category == "goods", services or category == "service")
+    return flags
+
+
+def report_rows(invoices):
+    """Return (invoice, cells_html) pairs for the bill report table.
+
+    Cached rows are fetched with one get_many; only the misses are rendered,
+    and their goods/services flags come from a single query.
+    """
+    gen = generation()
+    keys = [fragment_key("billreport_row", invoice, gen) for invoice in invoices]
+    cached = cache.get_many(keys)
+
+    misses = [invoice for invoice, key in zip(invoices, keys) if key not in cached]
+    if misses:
+        flags = _category_flags(misses)
+        rendered = {}
+        for invoice in misses:
+            has_goods, has_services = flags.get(
+                (invoice._meta.model_name, invoice.pk), (False, False))
+            rendered[fragment_key("billreport_row", invoice, gen)] = render_to_string(
+                "billreport_row.html",
+                {"invoice": invoice, "has_goods": has_goods, "has_services": has_services},
+            )
+        cache.set_many(rendered, FRAGMENT_TIMEOUT)
+        cached.update(rendered)
+
+    return [(invoice, mark_safe(cached[key])) for invoice, key in zip(invoices, keys)]
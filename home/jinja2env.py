@@ -0,0 +1,37 @@
+"""Jinja2 environment for the hand-converted templates in home/jinja2/.
+
+Values are finalized the way Django's engine renders a variable
+(localtime, localize, conditional escape), so both engines produce the
+same bytes for the same context.
+"""
+from django.conf import settings
+from django.templatetags.static import static
+from django.template import defaultfilters
+from django.utils.formats import localize
+from django.utils.html import conditional_escape
+from django.utils.timezone import template_localtime
+from jinja2 import Environment
+from markupsafe import Markup
+
+from .templatetags.custom_filters import mul
+
+
+def finalize(value):
+    return Markup(conditional_escape(localize(template_localtime(value))))
+
+
+def date(value, arg=None):
+    return defaultfilters.date(template_localtime(value), arg)
+
+
+def environment(**options):
+    options.setdefault("keep_trailing_newline", True)
+    options.setdefault("auto_reload", settings.DEBUG)
+    env = Environment(finalize=finalize, **options)
+    env.globals["static"] = static
+    env.filters.update({
+        "date": date,
+        "floatformat": defaultfilters.floatformat,
+        "mul": mul,
+    })
+    return env
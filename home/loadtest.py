@@ -0,0 +1,227 @@
+"""Simulated counter staff for load-testing a running instance.
+
+Each simulated user logs in to the admin with its own session and then,
+until the level's time is up, picks one task after another: entering an
+invoice with a few line items through the admin form, opening one of an
+invoice's print views, or running the bill report. Users only speak HTTP;
+the customers, vehicles, products and invoices they pick from are read
+up front by the caller, so the command must see the server's database.
+
+A request answered 503 by DatabaseLockedMiddleware is resubmitted after a
+short backoff, as the counter would; its latency includes the waiting.
+Only when the retries run out does it count as locked.
+"""
+import http.cookiejar
+import math
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Invoice, Product, Vehicle
+
+# Relative frequency of each task at the counter
+TASKS = {"invoice entry": 4, "print": 4, "bill report": 1}
+PRINT_PATHS = ("/invoice/{}/pdf/", "/invoice/{}/pdf/goods/", "/invoice/{}/pdf/services/")
+MAX_ITEMS = 5
+LOCK_RETRIES = 3
+LOCK_BACKOFF = 0.25
+TIMEOUT = 60
+
+
+class LoginFailed(Exception):
+    pass
+
+
+def load_fixtures(invoices=500):
+    """What the simulated users choose from; read once, before they start."""
+    return {
+        "vehicles": list(Vehicle.objects.values_list("customer_id", "id")),
+        "products": [(pk, str(price)) for pk, price in Product.objects.values_list("id", "price_excl_tax")],
+        "invoices": list(Invoice.objects.order_by("-id").values_list("id", flat=True)[:invoices]),
+    }
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # A redirect is the answer being measured, not a request to follow
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class SimulatedUser:
+    def __init__(self, base_url, username, password, fixtures, seed=None):
+        self.base_url = base_url.rstrip("/")
+        self.username = username
+        self.password = password
+        self.fixtures = fixtures
+        self.random = random.Random(seed)
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(self.cookies), _NoRedirect)
+        self.tasks = [task for task in TASKS if task != "print" or fixtures["invoices"]]
+        self.weights = [TASKS[task] for task in self.tasks]
+
+    def request(self, path, data=None):
+        """Status code of a GET, or of a form POST when ``data`` is given; 0 if unreachable."""
+        body = None
+        if data is not None:
+            data = dict(data, csrfmiddlewaretoken=self._csrf_token())
+            body = urllib.parse.urlencode(data, doseq=True).encode()
+        request = urllib.request.Request(self.base_url + path, data=body, headers={
+            # Django's CSRF check wants a same-origin Referer on HTTPS
+            "Referer": self.base_url + path,
+        })
+        try:
+            with self.opener.open(request, timeout=TIMEOUT) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code
+        except OSError:
+            return 0
+
+    def _csrf_token(self):
+        for cookie in self.cookies:
+            if cookie.name == settings.CSRF_COOKIE_NAME:
+                return cookie.value
+        return ""
+
+    def login(self):
+        self.request("/admin/login/")
+        status = self.request("/admin/login/", {
+            "username": self.username, "password": self.password, "next": "/admin/"})
+        if status != 302:
+            raise LoginFailed(f"Logging in as {self.username!r} at {self.base_url} answered {status}.")
+
+    # --- Tasks: each returns (status, whether that status is success) ---
+
+    def enter_invoice(self):
+        customer_id, vehicle_id = self.random.choice(self.fixtures["vehicles"])
+        items = self.random.sample(
+            self.fixtures["products"], min(self.random.randint(1, MAX_ITEMS), len(self.fixtures["products"])))
+        now = timezone.localtime()
+        data = {
+            "customer": customer_id,
+            "vehicle": vehicle_id,
+            "date_0": now.strftime("%Y-%m-%d"),
+            "date_1": now.strftime("%H:%M:%S"),
+            "seen_version": "",
+            "items-TOTAL_FORMS": len(items),
+            "items-INITIAL_FORMS": 0,
+            "items-MIN_NUM_FORMS": 0,
+            "items-MAX_NUM_FORMS": 1000,
+            "_save": "Save",
+        }
+        for index, (product_id, price) in enumerate(items):
+            data[f"items-{index}-product"] = product_id
+            data[f"items-{index}-qty"] = self.random.randint(1, 4)
+            data[f"items-{index}-price_excl_tax"] = price
+        # Saved invoices redirect to the changelist; a re-rendered form means it was refused
+        return self.request("/admin/home/invoice/add/", data), 302
+
+    def open_invoice_form(self):
+        return self.request("/admin/home/invoice/add/"), 200
+
+    def print_invoice(self):
+        path = self.random.choice(PRINT_PATHS).format(self.random.choice(self.fixtures["invoices"]))
+        return self.request(path), 200
+
+    def bill_report(self):
+        date_from = (timezone.localdate() - timezone.timedelta(days=30)).isoformat()
+        return self.request(f"/billreport/?date_from={date_from}"), 200
+
+    def timed(self, operation, call, records):
+        """Run ``call``, resubmitting while the database is locked, and record the outcome."""
+        start = time.perf_counter()
+        retries = 0
+        while True:
+            status, expected = call()
+            if status != 503 or retries == LOCK_RETRIES:
+                break
+            retries += 1
+            time.sleep(LOCK_BACKOFF * 2 ** (retries - 1) * (1 + self.random.random()))
+        latency = time.perf_counter() - start
+        outcome = "ok" if status == expected else "locked" if status == 503 else "error"
+        records.append((operation, latency, outcome, retries))
+
+    def run(self, deadline, think, records):
+        """Work the counter until ``deadline`` (a time.monotonic() value)."""
+        while time.monotonic() < deadline:
+            task = self.random.choices(self.tasks, self.weights)[0]
+            if task == "invoice entry":
+                # Loading the form and saving it are separate waits for the clerk
+                self.timed("invoice form", self.open_invoice_form, records)
+                self.timed("invoice save", self.enter_invoice, records)
+            elif task == "print":
+                self.timed("print", self.print_invoice, records)
+            else:
+                self.timed("bill report", self.bill_report, records)
+            if think:
+                time.sleep(self.random.uniform(0, 2 * think))
+
+
+def run_level(users, seconds, think=0.0):
+    """Let ``users`` (logged-in SimulatedUsers) work for ``seconds`` at once.
+
+    Returns the records, (operation, latency, outcome, lock retries) per
+    request, and the wall time they took.
+    """
+    records = []
+    deadline = time.monotonic() + seconds
+    start = time.perf_counter()
+    threads = [
+        # list.append is atomic, so the users share one list
+        threading.Thread(target=user.run, args=(deadline, think, records), daemon=True)
+        for user in users
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records, time.perf_counter() - start
+
+
+def percentile(ordered, share):
+    """Nearest-rank percentile of an ascending list."""
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(share * len(ordered)) - 1)]
+
+
+def summarize(records, elapsed):
+    latencies = sorted(latency for _operation, latency, _outcome, _retries in records)
+    count = len(records)
+    return {
+        "requests": count,
+        "throughput": count / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "error_rate": sum(outcome != "ok" for _o, _l, outcome, _r in records) / count if count else 0.0,
+        "locked_rate": sum(outcome == "locked" for _o, _l, outcome, _r in records) / count if count else 0.0,
+        "lock_retry_rate": sum(retries > 0 for _o, _l, _outcome, retries in records) / count if count else 0.0,
+    }
+
+
+def by_operation(records, elapsed):
+    grouped = {}
+    for record in records:
+        grouped.setdefault(record[0], []).append(record)
+    return {operation: summarize(group, elapsed) for operation, group in sorted(grouped.items())}
+
+
+def saturation(levels):
+    """Users at the last level whose throughput still grew by 10%, or None if it never stopped.
+
+    ``levels`` is [(users, summary)] in increasing order of users.
+    """
+    for (users, previous), (_next_users, current) in zip(levels, levels[1:]):
+        if current["throughput"] < previous["throughput"] * 1.1:
+            return users
+    return None
@@ -0,0 +1,57 @@
+"""Vehicle lookups behind the chained customer -> vehicle invoice widget."""
+import re
+
+from django.core.cache import cache
+
+from .models import Customer, Vehicle
+
+VEHICLE_LIST_TIMEOUT = 60
+PLATE_LOOKUP_LIMIT = 20
+
+
+def vehicle_list_key(customer_id):
+    return f"vehicles:customer:{customer_id}"
+
+
+def _result(vehicle_id, make, number, customer_id, customer_name):
+    return {
+        "id": str(vehicle_id),
+        "text": f"{make} ({number})",
+        "customer": str(customer_id),
+        "customer_text": customer_name or "Unnamed Customer",
+    }
+
+
+def customer_vehicles(customer_id):
+    """A customer's vehicles as select2 results, cached for a minute.
+
+    Reads through the vehicles relation's customer_id index; vehicle edits
+    drop the entry right away.
+    """
+    key = vehicle_list_key(customer_id)
+    results = cache.get(key)
+    if results is None:
+        name = Customer.objects.filter(pk=customer_id).values_list("name", flat=True).first()
+        results = [
+            _result(pk, make, number, customer_id, name)
+            for pk, make, number in Vehicle.objects.filter(customer_id=customer_id)
+            .order_by("number").values_list("pk", "make", "number")
+        ]
+        cache.set(key, results, VEHICLE_LIST_TIMEOUT)
+    return results
+
+
+def normalize_plate(plate):
+    """Bring typed plates to the stored LEA-1001 form ("lea 1001", "LEA1001")."""
+    plate = re.sub(r"[\s-]+", "-", plate.strip().upper())
+    return re.sub(r"^([A-Z]+)(\d)", r"\1-\2", plate)
+
+
+def vehicles_by_plate(plate, limit=PLATE_LOOKUP_LIMIT):
+    """Vehicles of any customer whose number starts with ``plate``, with their customer."""
+    vehicles = Vehicle.objects.filter(number__istartswith=normalize_plate(plate))
+    return [
+        _result(*row)
+        for row in vehicles.order_by("number").values_list(
+            "pk", "make", "number", "customer_id", "customer__name")[:limit]
+    ]
@@ -0,0 +1,185 @@
+"""Email invoice PDFs to customers, one message per customer.
+
+Rendering and sending overlap: this thread renders each customer's PDFs
+and hands the finished message to a small pool of sender threads over a
+bounded queue. Each sender opens one connection to the mail server and
+keeps it for the whole run, and all senders share one rate limit. Only
+this thread touches the database; senders report back and the delivery
+status of each invoice is recorded as results arrive.
+"""
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .archive import archive_queryset
+from .models import Invoice
+from .utils.lazy import LazyCallable
+
+# ReportLab loads on first use
+render_invoice_pdf = LazyCallable("home.utils.pdf.render_invoice_pdf")
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class RateLimiter:
+    """Spaces out sends across all sender threads: ``per_minute`` at most."""
+
+    def __init__(self, per_minute, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 60.0 / per_minute if per_minute else 0.0
+        self.clock = clock
+        self.sleep = sleep
+        self._next = None
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = self.clock()
+            start = now if self._next is None else max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            self.sleep(start - now)
+
+
+def build_message(customer, invoices):
+    """One email with every invoice of ``customer`` attached."""
+    context = {
+        "customer": customer,
+        "invoices": invoices,
+        "total": sum(invoice.total_incl_tax for invoice in invoices),
+    }
+    message = EmailMessage(
+        subject=render_to_string("invoice_email_subject.txt", context).strip(),
+        body=render_to_string("invoice_email.txt", context),
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[customer.email],
+    )
+    for invoice in invoices:
+        message.attach(f"{invoice.invoice_no}.pdf", render_invoice_pdf(invoice), "application/pdf")
+    return message
+
+
+def _connect(connection=None):
+    """Open a mail session; returns (connection, error), error "" on success.
+
+    The backend only keeps its session across send_messages() calls when
+    it was opened beforehand; otherwise each call connects anew.
+    """
+    try:
+        connection = connection or get_connection()
+        connection.open()
+    except Exception as exc:
+        return connection, f"No mail connection: {type(exc).__name__}: {exc}"
+    return connection, ""
+
+
+def _sender(jobs, results, limiter):
+    # One session for everything this worker sends
+    connection, broken = _connect()
+    try:
+        while True:
+            job = jobs.get()
+            if job is _DONE:
+                return
+            customer_id, invoice_ids, message = job
+            if broken:
+                # Keep taking jobs, or the renderer blocks on the full queue
+                results.put((customer_id, invoice_ids, broken))
+                continue
+            limiter.wait()
+            error = ""
+            try:
+                connection.send_messages([message])
+            except Exception as exc:
+                error = f"{type(exc).__name__}: {exc}"
+                # The session may be broken; start a new one for the next message
+                connection.close()
+                connection, broken = _connect(connection)
+            results.put((customer_id, invoice_ids, error))
+    finally:
+        if connection is not None:
+            connection.close()
+
+
+def _record(result, counts):
+    customer_id, invoice_ids, error = result
+    invoices = Invoice.objects.filter(id__in=invoice_ids)
+    if error:
+        invoices.update(email_status="failed")
+        counts["failed"] += len(invoice_ids)
+        logger.warning("Emailing invoices %s to customer %s failed: %s", invoice_ids, customer_id, error)
+    else:
+        invoices.update(email_status="sent", emailed_at=timezone.now())
+        counts["sent"] += len(invoice_ids)
+        counts["messages"] += 1
+
+
+def _drain(results, counts):
+    while True:
+        try:
+            _record(results.get_nowait(), counts)
+        except queue.Empty:
+            return
+
+
+def send_invoices(queryset, workers=None, per_minute=None):
+    """Email the invoices in ``queryset`` grouped per customer.
+
+    Returns counts: messages sent, and invoices sent, failed and skipped
+    for lack of an address (no_address).
+    """
+    workers = workers or settings.INVOICE_EMAIL_WORKERS
+    per_minute = settings.INVOICE_EMAIL_RATE_PER_MINUTE if per_minute is None else per_minute
+    counts = {"messages": 0, "sent": 0, "failed": 0, "no_address": 0}
+
+    invoices = archive_queryset().filter(pk__in=queryset.values("pk")).order_by("customer_id", "id")
+    by_customer = {}
+    for invoice in invoices:
+        by_customer.setdefault(invoice.customer_id, []).append(invoice)
+
+    without_address = [
+        invoice.pk for batch in by_customer.values() if not batch[0].customer.email
+        for invoice in batch
+    ]
+    Invoice.objects.filter(id__in=without_address).update(email_status="no_address")
+    counts["no_address"] = len(without_address)
+
+    jobs = queue.Queue(maxsize=settings.INVOICE_EMAIL_QUEUE_SIZE)
+    results = queue.Queue()
+    limiter = RateLimiter(per_minute)
+    threads = [
+        threading.Thread(target=_sender, args=(jobs, results, limiter), daemon=True)
+        for _ in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for customer_id, batch in by_customer.items():
+            customer = batch[0].customer
+            if not customer.email:
+                continue
+            invoice_ids = [invoice.pk for invoice in batch]
+            try:
+                message = build_message(customer, batch)
+            except Exception as error:
+                _record((customer_id, invoice_ids, f"Rendering failed: {error}"), counts)
+                continue
+            # Blocks while the senders are behind, so memory stays bounded
+            jobs.put((customer_id, invoice_ids, message))
+            _drain(results, counts)
+    finally:
+        for _thread in threads:
+            jobs.put(_DONE)
+        for thread in threads:
+            thread.join()
+    _drain(results, counts)
+    return counts
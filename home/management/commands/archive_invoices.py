@@ -0,0 +1,57 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from home.archive import record_archives, render_archive_batch
+from home.memprofile import profile_memory
+from home.models import Invoice
+
+
+class Command(BaseCommand):
+    help = "Render and archive the final PDFs of paid invoices that have not been archived yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=os.cpu_count() or 1,
+            help="Number of worker processes rendering PDFs (1 renders inline).",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=50,
+            help="Invoices handed to a worker at a time.",
+        )
+
+    @profile_memory("manage.py archive_invoices")
+    def handle(self, *args, **options):
+        workers = max(1, options["workers"])
+        batch_size = max(1, options["batch_size"])
+
+        ids = list(
+            Invoice.objects.filter(status="paid", archived_pdfs__isnull=True)
+            .order_by("id").values_list("id", flat=True)
+        )
+        batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+        if not batches:
+            self.stdout.write("Nothing to archive.")
+            return
+
+        stored = 0
+        if workers == 1:
+            for batch in batches:
+                rows = render_archive_batch(batch)
+                record_archives(rows)
+                stored += len(rows)
+        else:
+            # Forked workers must not inherit the parent's DB connection.
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as pool:
+                futures = [pool.submit(render_archive_batch, batch) for batch in batches]
+                for future in as_completed(futures):
+                    rows = future.result()
+                    record_archives(rows)
+                    stored += len(rows)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {stored} PDFs for {len(ids)} invoices."))
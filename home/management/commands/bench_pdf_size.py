@@ -0,0 +1,45 @@
+import itertools
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from home.archive import archive_queryset
+from home.utils.pdf import render_invoice_pdf, render_invoices_pdf
+
+
+class Command(BaseCommand):
+    help = "Compare invoice PDF size in the default and compact output modes."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--invoices", type=int, default=1000,
+            help="Invoices to render; existing ones are reused when there are fewer.")
+        parser.add_argument("--bill", choices=["", "F-", "P-"], default="", help="Bill type prefix.")
+
+    def handle(self, *args, **options):
+        invoices = list(archive_queryset().order_by("-id")[:options["invoices"]])
+        if not invoices:
+            raise CommandError("No invoices to render.")
+        invoices = list(itertools.islice(itertools.cycle(invoices), options["invoices"]))
+        count = len(invoices)
+
+        rows = []
+        for label, compact in (("default", False), ("compact", True)):
+            start = time.perf_counter()
+            total = sum(
+                len(render_invoice_pdf(invoice, options["bill"], invariant=True, compact=compact))
+                for invoice in invoices
+            )
+            rows.append((f"{label}, one file each", total, time.perf_counter() - start))
+        start = time.perf_counter()
+        merged = len(render_invoices_pdf(invoices, options["bill"], invariant=True, compact=True))
+        rows.append(("compact, merged", merged, time.perf_counter() - start))
+
+        baseline = rows[0][1]
+        self.stdout.write(f"{count} invoices:")
+        for label, total, elapsed in rows:
+            self.stdout.write(
+                f"  {label:<24} {total / count / 1024:8.1f} KiB per invoice "
+                f"{total / 1024 / 1024:8.1f} MiB total  {baseline / total:5.1f}x smaller "
+                f"{elapsed * 1000 / count:6.1f} ms per invoice"
+            )
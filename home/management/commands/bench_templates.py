@@ -0,0 +1,60 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.template import engines
+from django.template.loader import render_to_string
+
+from home.archive import archive_queryset
+from home.views import invoice_context
+
+
+def _uncached(contexts):
+    # A generation no fragment is stored under, so every render is a full
+    # one; clearing the cache instead would drop sessions, or all of Redis
+    generation = uuid.uuid4().hex
+    return [dict(context, fragment_generation=generation) for context in contexts]
+
+
+class Command(BaseCommand):
+    help = "Compare per-invoice render time of index.html under the Django and Jinja2 engines."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--invoices", type=int, default=200, help="Invoices to render.")
+        parser.add_argument("--rounds", type=int, default=3, help="Best of this many rounds.")
+
+    def handle(self, *args, **options):
+        try:
+            engines["jinja2"]
+        except KeyError:
+            raise CommandError("The jinja2 template engine is not configured (is Jinja2 installed?).")
+
+        invoices = list(archive_queryset().order_by("-id")[:options["invoices"]])
+        if not invoices:
+            raise CommandError("No invoices to render.")
+        contexts = [invoice_context(invoice) for invoice in invoices]
+
+        results = {}
+        for engine in ("django", "jinja2"):
+            best = None
+            for _round in range(options["rounds"]):
+                # Measure a full render, not a hit on index.html's fragment cache
+                fresh = _uncached(contexts)
+                start = time.perf_counter()
+                for context in fresh:
+                    render_to_string("index.html", context, using=engine)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results[engine] = best / len(contexts)
+
+        mismatches = 0
+        for context in _uncached(contexts):
+            if render_to_string("index.html", context, using="django") != \
+                    render_to_string("index.html", context, using="jinja2"):
+                mismatches += 1
+
+        for engine, per_invoice in results.items():
+            self.stdout.write(f"{engine:>7}: {per_invoice * 1000:8.3f} ms per invoice")
+        self.stdout.write(f"Speedup: {results['django'] / results['jinja2']:.1f}x over {len(contexts)} invoices")
+        if mismatches:
+            self.stdout.write(self.style.WARNING(f"{mismatches} invoices rendered differently"))
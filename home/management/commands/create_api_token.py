@@ -0,0 +1,22 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from home.models import ApiToken
+
+
+class Command(BaseCommand):
+    help = "Issue a JSON API token for a user and print its key (shown only once)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("username")
+        parser.add_argument("--name", default="api", help="Label for the client, e.g. 'POS 1'.")
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        try:
+            user = User.objects.get(username=options["username"])
+        except User.DoesNotExist:
+            raise CommandError(f"No user named {options['username']!r}.")
+        token, key = ApiToken.issue(user, options["name"])
+        self.stdout.write(f"Token {token.name!r} for {user}; send it as 'Authorization: Token <key>':")
+        self.stdout.write(key)
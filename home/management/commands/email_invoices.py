@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from home.coldstore import date_range_filter
+from home.mailing import send_invoices
+from home.memprofile import profile_memory
+from home.models import Invoice
+
+
+class Command(BaseCommand):
+    help = "Email invoice PDFs to customers, one message per customer."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--date-from", help="First invoice date (YYYY-MM-DD).")
+        parser.add_argument("--date-to", help="Last invoice date (YYYY-MM-DD).")
+        parser.add_argument("--customer", type=int, action="append", help="Only this customer id (repeatable).")
+        parser.add_argument("--status", action="append", help="Only invoices with this status (repeatable).")
+        parser.add_argument(
+            "--resend", action="store_true", help="Include invoices that were already emailed.")
+        parser.add_argument("--workers", type=int, help="Sender threads, each with one SMTP connection.")
+        parser.add_argument("--rate", type=float, help="Messages per minute across all workers (0: no limit).")
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Count what would be sent without sending.")
+
+    @profile_memory("manage.py email_invoices")
+    def handle(self, *args, **options):
+        dates = {}
+        for name in ("date_from", "date_to"):
+            if options[name]:
+                dates[name] = parse_date(options[name])
+                if dates[name] is None:
+                    raise CommandError(f"--{name.replace('_', '-')} must be a date (YYYY-MM-DD).")
+
+        queryset = Invoice.objects.filter(**date_range_filter(**dates))
+        if options["customer"]:
+            queryset = queryset.filter(customer_id__in=options["customer"])
+        if options["status"]:
+            queryset = queryset.filter(status__in=options["status"])
+        if not options["resend"]:
+            queryset = queryset.exclude(email_status="sent")
+
+        if options["dry_run"]:
+            invoices = queryset.count()
+            customers = queryset.values("customer").distinct().count()
+            self.stdout.write(f"{invoices} invoices for {customers} customers would be emailed.")
+            return
+
+        counts = send_invoices(queryset, workers=options["workers"], per_minute=options["rate"])
+        self.stdout.write(
+            f"{counts['sent']} invoices sent in {counts['messages']} messages, "
+            f"{counts['failed']} failed, {counts['no_address']} without an email address."
+        )
@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from home.loadtest import (
+    LoginFailed, SimulatedUser, by_operation, load_fixtures, run_level, saturation, summarize,
+)
+
+
+def _levels(value):
+    try:
+        levels = sorted({int(part) for part in value.split(",")})
+    except ValueError:
+        raise CommandError(f"--users takes a comma-separated list of numbers, not {value!r}.")
+    if not levels or levels[0] < 1:
+        raise CommandError("--users must be positive.")
+    return levels
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive a running server with simulated counter staff at rising concurrency and report "
+        "throughput, latency percentiles, error and lock-retry rates per level. Saved invoices "
+        "stay in the database, so point it at a copy."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000", help="Server to load.")
+        parser.add_argument("--username", required=True, help="Staff account every simulated user logs in as.")
+        parser.add_argument("--password", required=True)
+        parser.add_argument("--users", default="1,2,4,8,16", help="Concurrent users per level.")
+        parser.add_argument("--duration", type=float, default=20, help="Seconds per level.")
+        parser.add_argument("--think", type=float, default=0.0,
+                            help="Mean seconds a user pauses between tasks (0 for flat out).")
+        parser.add_argument("--seed", type=int, default=None, help="Make the task mix repeatable.")
+
+    def handle(self, *args, **options):
+        levels = _levels(options["users"])
+        fixtures = load_fixtures()
+        if not fixtures["vehicles"] or not fixtures["products"]:
+            raise CommandError("Need at least one vehicle and one product to enter invoices.")
+
+        seed = options["seed"]
+        users = [
+            SimulatedUser(options["url"], options["username"], options["password"], fixtures,
+                          seed=None if seed is None else seed + index)
+            for index in range(levels[-1])
+        ]
+        # Logging in hashes the password; do it once per user, before any level
+        try:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                list(pool.map(SimulatedUser.login, users))
+        except LoginFailed as error:
+            raise CommandError(str(error))
+
+        self.stdout.write(
+            f"{'users':>5} {'requests':>9} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+            f"{'errors':>7} {'locked':>7} {'retried':>8}")
+        results = []
+        for count in levels:
+            records, elapsed = run_level(users[:count], options["duration"], options["think"])
+            summary = summarize(records, elapsed)
+            results.append((count, summary))
+            self.stdout.write(self._row(f"{count:>5}", summary))
+            if options["verbosity"] > 1:
+                for operation, detail in by_operation(records, elapsed).items():
+                    self.stdout.write(self.style.HTTP_INFO(self._row(f"{'':>5}", detail, f"  {operation}")))
+
+        knee = saturation(results)
+        peak_users, peak = max(results, key=lambda result: result[1]["throughput"])
+        self.stdout.write(f"Peak throughput {peak['throughput']:.1f} req/s with {peak_users} users.")
+        if len(results) < 2:
+            return
+        if knee is None:
+            self.stdout.write("Throughput still rising at the highest level; add more users.")
+        else:
+            self.stdout.write(self.style.WARNING(f"Throughput stops scaling past {knee} users."))
+
+    def _row(self, users, summary, label=""):
+        return (
+            f"{users} {summary['requests']:>9} {summary['throughput']:>8.1f} "
+            f"{summary['p50'] * 1000:>8.0f} {summary['p95'] * 1000:>8.0f} {summary['p99'] * 1000:>8.0f} "
+            f"{summary['error_rate']:>7.1%} {summary['locked_rate']:>7.1%} {summary['lock_retry_rate']:>8.1%}"
+            f"{label}"
+        )
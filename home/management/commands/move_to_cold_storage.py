@@ -0,0 +1,42 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from home.coldstore import CLOSED_STATUSES, archive_invoices
+from home.memprofile import profile_memory
+
+
+class Command(BaseCommand):
+    help = "Move closed invoices older than a cutoff into the archived invoice tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--before", help="Archive invoices dated before this day (YYYY-MM-DD).")
+        parser.add_argument(
+            "--older-than-days", type=int, default=365,
+            help="Cutoff relative to today when --before is not given.",
+        )
+        parser.add_argument(
+            "--status", action="append",
+            help=f"Statuses that count as closed (default: {', '.join(CLOSED_STATUSES)}).",
+        )
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    @profile_memory("manage.py move_to_cold_storage")
+    def handle(self, *args, **options):
+        if options["before"]:
+            before = parse_date(options["before"])
+            if before is None:
+                raise CommandError("--before must be a date like 2025-01-31")
+        else:
+            before = timezone.localdate() - datetime.timedelta(days=options["older_than_days"])
+
+        moved = archive_invoices(
+            before,
+            statuses=tuple(options["status"] or CLOSED_STATUSES),
+            batch_size=max(1, options["batch_size"]),
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Moved {moved} invoices dated before {before} to cold storage."))
@@ -0,0 +1,73 @@
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Libraries that should only load when a PDF, report or export actually runs
+HEAVY_MODULES = ("reportlab", "numpy", "openpyxl", "weasyprint", "xhtml2pdf", "pypdf", "PIL")
+
+# What a web worker does before serving its first request
+BOOT_SCRIPT = (
+    "import django; django.setup(); "
+    "from django.urls import get_resolver; get_resolver().url_patterns"
+)
+
+
+def parse_importtime(output):
+    """Parse ``python -X importtime`` output.
+
+    Returns (module, self_us, cumulative_us, depth) tuples; depth 0 modules
+    were imported directly by the boot script.
+    """
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+class Command(BaseCommand):
+    help = "Boot Django in a fresh interpreter and report import time per module."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--top", type=int, default=20, help="Slowest modules to list.")
+        parser.add_argument(
+            "--check", action="store_true",
+            help="Exit with an error if any heavy module is imported at startup.",
+        )
+
+    def handle(self, *args, **options):
+        # SETTINGS_MODULE reads None while override_settings is active, as in tests
+        module = settings.SETTINGS_MODULE or os.environ["DJANGO_SETTINGS_MODULE"]
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=module)
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", BOOT_SCRIPT],
+            capture_output=True, text=True, env=env, cwd=settings.BASE_DIR,
+        )
+        if result.returncode:
+            raise CommandError(f"Startup failed:\n{result.stderr}")
+
+        rows = parse_importtime(result.stderr)
+        total_us = sum(row[2] for row in rows if row[3] == 0)
+        self.stdout.write(f"Startup imports: {len(rows)} modules, {total_us / 1000:.1f} ms")
+
+        self.stdout.write(f"\nSlowest {options['top']} modules (cumulative ms, self ms):")
+        for name, self_us, cumulative_us, _depth in sorted(rows, key=lambda r: -r[2])[:options["top"]]:
+            self.stdout.write(f"  {cumulative_us / 1000:8.1f} {self_us / 1000:8.1f}  {name}")
+
+        heavy = sorted({
+            row[0].split(".")[0] for row in rows
+            if row[0].split(".")[0] in HEAVY_MODULES
+        })
+        if heavy:
+            message = "Heavy modules imported at startup: " + ", ".join(heavy)
+            if options["check"]:
+                raise CommandError(message)
+            self.stdout.write(self.style.WARNING(message))
+        else:
+            self.stdout.write(self.style.SUCCESS("No heavy modules imported at startup."))
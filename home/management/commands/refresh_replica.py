@@ -0,0 +1,31 @@
+import os
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+
+class Command(BaseCommand):
+    help = "Copy the default SQLite database to the local read-replica snapshot."
+
+    def handle(self, *args, **options):
+        default = connections["default"]
+        if default.vendor != "sqlite":
+            raise CommandError("refresh_replica only snapshots a SQLite default database.")
+
+        target = str(settings.REPLICA_SQLITE_PATH)
+        tmp_path = target + ".tmp"
+        default.ensure_connection()
+        taken = time.time()
+        # The backup API copies a consistent snapshot while writers continue
+        with sqlite3.connect(tmp_path) as snapshot:
+            default.connection.backup(snapshot)
+        snapshot.close()
+        # The router reads the snapshot's age from its modification time
+        os.utime(tmp_path, (taken, taken))
+        os.replace(tmp_path, target)
+        self.stdout.write(self.style.SUCCESS(f"Replica snapshot written to {target}."))
+        if not settings.REPLICA_ENABLED:
+            self.stdout.write("Set REPLICA_ENABLED=1 to read reports from it.")
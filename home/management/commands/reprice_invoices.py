@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+
+from home.memprofile import profile_memory
+from home.repricing import REPRICE_STATUSES, impact, reprice, stale_items
+
+
+class Command(BaseCommand):
+    help = "Update items of open invoices to current product prices and tax rates."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--product", type=int, action="append",
+            help="Only items of this product id (repeatable).")
+        parser.add_argument(
+            "--tax", type=int, action="append",
+            help="Only items in this tax category id (repeatable).")
+        parser.add_argument(
+            "--status", action="append",
+            help=f"Invoice statuses to reprice (default: {', '.join(REPRICE_STATUSES)}).",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Report the effect on each invoice without changing anything.")
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    @profile_memory("manage.py reprice_invoices")
+    def handle(self, *args, **options):
+        items = stale_items(
+            statuses=tuple(options["status"] or REPRICE_STATUSES),
+            products=options["product"],
+            taxes=options["tax"],
+        )
+        if options["dry_run"]:
+            report = impact(items)
+            for row in report:
+                self.stdout.write(
+                    f"{row['invoice__invoice_no']:<20} {row['items']:>4} items "
+                    f"{row['old_total']:>12.2f} -> {row['new_total']:>12.2f} "
+                    f"({row['change']:+.2f})"
+                )
+            self.stdout.write(
+                f"{sum(row['items'] for row in report)} items on {len(report)} invoices would change "
+                f"by {sum(row['change'] for row in report):+.2f} PKR in total."
+            )
+            return
+
+        repriced, invoices = reprice(items, batch_size=max(1, options["batch_size"]))
+        self.stdout.write(self.style.SUCCESS(
+            f"Repriced {repriced} items on {invoices} invoices."))
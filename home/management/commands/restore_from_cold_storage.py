@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from home.coldstore import date_range_filter, restore_invoices
+from home.models import ColdInvoice
+
+
+class Command(BaseCommand):
+    help = "Move archived invoices back into the active invoice tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="date_from", help="First day to restore (YYYY-MM-DD).")
+        parser.add_argument("--to", dest="date_to", help="Last day to restore (YYYY-MM-DD).")
+        parser.add_argument("--invoice-no", action="append", help="Restore specific invoices.")
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        date_from = parse_date(options["date_from"] or "")
+        date_to = parse_date(options["date_to"] or "")
+        if not (date_from or date_to or options["invoice_no"]):
+            raise CommandError("Give --from/--to or --invoice-no to choose what to restore.")
+
+        queryset = ColdInvoice.objects.filter(**date_range_filter(date_from, date_to))
+        if options["invoice_no"]:
+            queryset = queryset.filter(invoice_no__in=options["invoice_no"])
+        restored = restore_invoices(queryset, batch_size=max(1, options["batch_size"]))
+        self.stdout.write(self.style.SUCCESS(f"Restored {restored} invoices."))
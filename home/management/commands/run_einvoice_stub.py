@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from home.einvoice_stub import StubAuthority
+
+
+class Command(BaseCommand):
+    help = "Serve a local stand-in for the FBR/PRA e-invoice APIs."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--delay", type=float, default=0, help="Seconds to hold each request.")
+
+    def handle(self, *args, **options):
+        stub = StubAuthority(port=options["port"], delay=options["delay"])
+        self.stdout.write(
+            f"Set FBR_API_URL={stub.url}/fbr/ and PRA_API_URL={stub.url}/pra/; Ctrl-C to stop.")
+        try:
+            stub.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stub.server.server_close()
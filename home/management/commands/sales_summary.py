@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from home.memprofile import profile_memory
+from home.models import Customer, InvoiceItem, Taxes
+from home.reports import GROUP_KEYS, item_totals
+
+
+class Command(BaseCommand):
+    help = "Print line item totals grouped by customer, month and/or category."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--by", action="append", choices=sorted(GROUP_KEYS),
+            help="Group key; repeat to group by several (default: customer).",
+        )
+        parser.add_argument("--status", help="Only include invoices with this status.")
+
+    @profile_memory("manage.py sales_summary")
+    def handle(self, *args, **options):
+        by = tuple(options["by"] or ["customer"])
+        queryset = InvoiceItem.objects.all()
+        if options["status"]:
+            queryset = queryset.filter(invoice__status=options["status"])
+
+        names = {}
+        if "customer" in by:
+            names["customer"] = dict(Customer.objects.values_list("id", "name"))
+        if "category" in by:
+            names["category"] = dict(Taxes.objects.values_list("id", "name"))
+
+        for row in item_totals(queryset, by):
+            labels = []
+            for key in by:
+                value = row[key]
+                if key == "month":
+                    labels.append(value.strftime("%Y-%m"))
+                else:
+                    labels.append(str(names[key].get(value, "-")))
+            self.stdout.write(
+                f"{' | '.join(labels)}: {row['items']} items, "
+                f"excl {row['total_excl_tax']}, tax {row['total_tax']}, "
+                f"incl {row['total_incl_tax']}"
+            )
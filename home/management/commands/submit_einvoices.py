@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from home.einvoice import AUTHORITIES, submit_due
+
+
+class Command(BaseCommand):
+    help = "Report paid invoices waiting in the e-invoice outbox to FBR and PRA."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--authority", action="append", choices=sorted(AUTHORITIES),
+            help="Only this authority (repeatable; default: all).")
+        parser.add_argument(
+            "--loop", action="store_true",
+            help="Keep polling the outbox instead of exiting once it is drained.")
+        parser.add_argument("--interval", type=float, default=10, help="Seconds between polls with --loop.")
+
+    def handle(self, *args, **options):
+        while True:
+            counts = submit_due(authorities=options["authority"])
+            if any(counts.values()) or not options["loop"]:
+                self.stdout.write(
+                    f"{counts['submitted']} submitted, {counts['not_required']} not required, "
+                    f"{counts['retrying']} to retry, {counts['failed']} failed"
+                )
+            if not options["loop"]:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,203 @@
+"""Opt-in memory profiling with tracemalloc for exports, reports and imports.
+
+Decorate a view, admin action or management command's handle() with
+``profile_memory`` and mark its phases with ``stage``. Nothing happens
+unless MEMORY_PROFILING is on; then each call records its peak traced
+memory, what it still holds when it returns (retained), and the source
+lines that allocated most, per stage and overall. A streaming response
+is measured until its last chunk has been sent.
+
+Records go to the "home.memprofile" logger as JSON and to the shared
+cache, where the staff page at /memory/ lists the most recent ones.
+
+tracemalloc sees every thread of the process, so only one call is
+profiled at a time; calls that arrive meanwhile run unprofiled.
+"""
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from .utils.generation import shared_cache
+
+logger = logging.getLogger(__name__)
+
+RECENT_KEY = "memprofile:recent"
+
+_active = ContextVar("memprofile_active", default=None)
+_lock = threading.Lock()
+# Allocations by these files are the profiler's own or the import system's
+_IGNORED = (tracemalloc.__file__, __file__, "<frozen importlib._bootstrap>",
+            "<frozen importlib._bootstrap_external>")
+
+
+def enabled():
+    return settings.MEMORY_PROFILING
+
+
+def _filtered(snapshot):
+    return snapshot.filter_traces(
+        [tracemalloc.Filter(False, filename) for filename in _IGNORED])
+
+
+def _top_sites(before, after, limit):
+    """The lines whose allocations grew most between two snapshots."""
+    sites = []
+    for stat in _filtered(after).compare_to(_filtered(before), "lineno")[:limit]:
+        if stat.size_diff <= 0:
+            break
+        frame = stat.traceback[0]
+        sites.append({
+            "site": f"{os.path.relpath(frame.filename, settings.BASE_DIR)}:{frame.lineno}",
+            "size": stat.size_diff,
+            "count": stat.count_diff,
+        })
+    return sites
+
+
+class _Profile:
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+        self._open = []  # peaks of the stages in progress, innermost last
+        self.started_at = timezone.now()
+        self.start = time.perf_counter()
+        self.snapshot = tracemalloc.take_snapshot()
+        self.current, _peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        self.peak = self.current
+
+    def _observe(self):
+        """Fold the peak since the last reset into every open stage, then reset it."""
+        current, peak = tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, peak)
+        for entry in self._open:
+            entry[0] = max(entry[0], peak)
+        tracemalloc.reset_peak()
+        return current
+
+    @contextlib.contextmanager
+    def stage(self, label):
+        snapshot = tracemalloc.take_snapshot()
+        current = self._observe()
+        entry = [current]
+        self._open.append(entry)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = self._observe()
+            self._open.remove(entry)
+            self.stages.append({
+                "label": label,
+                "duration_ms": round((time.perf_counter() - start) * 1000, 1),
+                "peak_bytes": entry[0] - current,
+                "retained_bytes": end - current,
+                "top": _top_sites(snapshot, tracemalloc.take_snapshot(), settings.MEMORY_PROFILE_TOP),
+            })
+
+    def finish(self):
+        current = self._observe()
+        return {
+            "name": self.name,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round((time.perf_counter() - self.start) * 1000, 1),
+            "peak_bytes": self.peak - self.current,
+            "retained_bytes": current - self.current,
+            "top": _top_sites(self.snapshot, tracemalloc.take_snapshot(), settings.MEMORY_PROFILE_TOP),
+            "stages": self.stages,
+        }
+
+
+def _begin(name):
+    if not _lock.acquire(blocking=False):
+        return None, False
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    profile = _Profile(name)
+    _active.set(profile)
+    return profile, started_tracing
+
+
+def _end(profile, started_tracing):
+    try:
+        record = profile.finish()
+    finally:
+        # Not a token reset: a streamed response may finish in another context
+        _active.set(None)
+        if started_tracing:
+            tracemalloc.stop()
+        _lock.release()
+    publish(record)
+    return record
+
+
+def publish(record):
+    logger.info(json.dumps(record), extra={"memory_profile": record})
+    cache = shared_cache()
+    recent = cache.get(RECENT_KEY) or []
+    cache.set(RECENT_KEY, [record] + recent[:settings.MEMORY_PROFILE_KEEP - 1], None)
+
+
+def recent_profiles():
+    return shared_cache().get(RECENT_KEY) or []
+
+
+def stage(label):
+    """Record a phase of the profiled call; a no-op when nothing is being profiled."""
+    profile = _active.get()
+    if profile is None:
+        return contextlib.nullcontext()
+    return profile.stage(label)
+
+
+def _streamed(profile, started_tracing, content):
+    try:
+        with profile.stage("stream"):
+            yield from content
+    finally:
+        _end(profile, started_tracing)
+
+
+def profile_memory(name=None):
+    """Decorator: profile each call when MEMORY_PROFILING is on.
+
+    ``name`` defaults to the function's module and qualified name. Inside
+    a call that is already being profiled the function becomes a stage.
+    """
+    def decorator(func):
+        label = name or f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            if _active.get() is not None:
+                with stage(label):
+                    return func(*args, **kwargs)
+            profile, started_tracing = _begin(label)
+            if profile is None:
+                return func(*args, **kwargs)
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                _end(profile, started_tracing)
+                raise
+            if isinstance(result, StreamingHttpResponse):
+                # The rows are produced while the response is sent
+                result.streaming_content = _streamed(profile, started_tracing, result.streaming_content)
+                return result
+            _end(profile, started_tracing)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,112 @@
+import logging
+import sys
+
+from django.conf import settings
+from django.core.signals import got_request_exception
+from django.db import OperationalError
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+
+from .storage import brotli, accepted_encodings
+
+logger = logging.getLogger(__name__)
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """Compress dynamic responses, preferring Brotli over gzip.
+
+    Streaming responses are left to GZipMiddleware so each chunk is still
+    flushed to the client as soon as it is produced. So are pages that
+    carry a CSRF token: GZipMiddleware pads those with random bytes
+    against BREACH, which Brotli has no room for.
+    """
+
+    brotli_quality = 5
+
+    def process_response(self, request, response):
+        if (
+            brotli is None
+            or response.streaming
+            # get_token() was called: the CSRF cookie goes out with the page
+            or settings.CSRF_COOKIE_NAME in response.cookies
+            or "br" not in accepted_encodings(request)
+        ):
+            return super().process_response(request, response)
+
+        if len(response.content) < 200:
+            return response
+        if response.has_header("Content-Encoding"):
+            return response
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+        compressed = brotli.compress(response.content, quality=self.brotli_quality)
+        if len(compressed) >= len(response.content):
+            return response
+
+        response.content = compressed
+        response["Content-Length"] = str(len(compressed))
+        response["Content-Encoding"] = "br"
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response.headers["ETag"] = "W/" + etag
+        return response
+
+
+class ProfilerMiddleware:
+    """Run a staff member's request under the sampling profiler on ?_profile=1.
+
+    Requests without the flag cost one substring test.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if (
+            "_profile=" not in request.META.get("QUERY_STRING", "")
+            or request.GET.get("_profile") != "1"
+            or not request.user.is_staff
+        ):
+            return self.get_response(request)
+        from .profiling import profile_request
+        return profile_request(request, self.get_response)
+
+
+def _is_lock(error):
+    return isinstance(error, OperationalError) and "database is locked" in str(error)
+
+
+@receiver(got_request_exception)
+def note_database_lock(sender, request=None, **kwargs):
+    # Sent while Django turns the exception into a 500, so it is still current
+    if request is not None and _is_lock(sys.exc_info()[1]):
+        request.database_locked = True
+
+
+class DatabaseLockedMiddleware:
+    """Answer 503 with Retry-After when SQLite's write lock was not had in time.
+
+    Otherwise the request fails as a 500 like any bug; this way clients
+    (and the load_test command) can tell contention apart and resubmit.
+    Django turns an exception into a 500 at the layer that raised it, so
+    the 500 is swapped here on the way out. That covers locks raised in
+    the view and in any middleware below this one, such as the session
+    save or a stored request profile; it goes first in MIDDLEWARE.
+    """
+
+    retry_after = 1
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.status_code != 500 or not getattr(request, "database_locked", False):
+            return response
+        logger.warning("Database locked: %s %s", request.method, request.path)
+        response = HttpResponse("The database is busy, please try again.", status=503,
+                                content_type="text/plain; charset=utf-8")
+        response["Retry-After"] = str(self.retry_after)
+        return response
@@ -1,4 +1,11 @@
-from django.db import models
+import datetime
+import hashlib
+import secrets
+from decimal import Decimal
+
+from django.db import models, transaction
+from django.db.models import Sum
+from django.db.models.functions import Coalesce, Round
 from django.utils import timezone
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
@@ -14,11 +21,21 @@ from django.dispatch import receiver
 #     def __str__(self):
 #         return self.name
 
+class StaleInvoiceError(Exception):
+    """The invoice was changed by someone else since it was loaded."""
+
+    def __init__(self, invoice):
+        super().__init__(f"Invoice {invoice.invoice_no} was changed by someone else")
+        self.invoice = invoice
+
+
 class Customer(models.Model):
     name = models.CharField(max_length=255)
     address = models.TextField(blank=True, null=True)
     srtn = models.CharField(max_length=50, blank=True, null=True)
     ntn = models.CharField(max_length=50, blank=True, null=True)
+    # Where email_invoices sends this customer's invoices
+    email = models.EmailField(blank=True, default="")
 
     def __str__(self):
         return self.name or "Unnamed Customer"
@@ -28,7 +45,8 @@ class Vehicle(models.Model):
     customer = models.ForeignKey(
         Customer, related_name="vehicles", on_delete=models.CASCADE)
     make = models.CharField(max_length=50)
-    number = models.CharField(max_length=50)
+    # Indexed for the plate-number lookup on the invoice form
+    number = models.CharField(max_length=50, db_index=True)
 
     def __str__(self):
         return f"{self.make} ({self.number})"
@@ -50,6 +68,14 @@ class Product(models.Model):
         return self.name
 
 
+EMAIL_STATUS_CHOICES = [
+    ("", "Not sent"),
+    ("sent", "Sent"),
+    ("failed", "Failed"),
+    ("no_address", "No email address"),
+]
+
+
 class Invoice(models.Model):
     STATUS_CHOICES = [
         ("unpaid", "Unpaid"),
@@ -70,22 +96,79 @@ class Invoice(models.Model):
     total_tax = models.DecimalField(max_digits=12, decimal_places=2, default=0)
     total_incl_tax = models.DecimalField(max_digits=12, decimal_places=2, default=0)
 
-    def save(self, *args, **kwargs):
+    # Bumped on every change; keys cached fragments of this invoice
+    version = models.PositiveIntegerField(default=1, editable=False)
+
+    # Numbers issued by the tax authorities (see home/einvoice.py)
+    fbr_invoice_no = models.CharField(max_length=64, blank=True, default="", editable=False)
+    pra_invoice_no = models.CharField(max_length=64, blank=True, default="", editable=False)
+
+    # Last delivery by email (see home/mailing.py)
+    email_status = models.CharField(
+        max_length=20, choices=EMAIL_STATUS_CHOICES, blank=True, default="", editable=False)
+    emailed_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Covers the customer statement query (grouped by status, customer;
+            # aged by date; summing total_incl_tax) without touching the table
+            models.Index(
+                fields=["status", "customer", "date", "total_incl_tax"],
+                name="invoice_status_cust_date",
+            ),
+        ]
+
+    def save(self, *args, expected_version=None, **kwargs):
+        """Save the invoice; with ``expected_version``, only if nobody else has.
+
+        Raises StaleInvoiceError when the stored version has moved on since
+        the editor loaded it.
+        """
         # Auto-generate invoice number
         if not self.invoice_no:
-            last_invoice = Invoice.objects.order_by("-id").first()
-            if last_invoice and last_invoice.invoice_no.startswith("MFES"):
-                last_no = int(last_invoice.invoice_no.replace("MFES", ""))
-                self.invoice_no = f"MFES{last_no+1:05d}"
+            self.invoice_no = Invoice.allocate_numbers(1)[0]
+        elif self.pk:
+            if expected_version is not None:
+                self.claim_version(expected_version)
+                self.version = expected_version + 1
             else:
-                self.invoice_no = "MFES00001"
+                self.version = models.F("version") + 1
         super().save(*args, **kwargs)
+        if isinstance(self.version, models.expressions.Combinable):
+            self.refresh_from_db(fields=["version"])
 
     def update_totals(self):
-        self.total_excl_tax = sum(item.price_excl_tax * item.qty for item in self.items.all())
-        self.total_tax = sum(item.tax_amount for item in self.items.all())
-        self.total_incl_tax = sum(item.price_incl_tax for item in self.items.all())
-        super().save(update_fields=["total_excl_tax", "total_tax", "total_incl_tax"])
+        with transaction.atomic():
+            # Wait for other writers of this invoice (row locks where the
+            # backend has them), then sum the items in the same statement
+            # that stores the totals, so no concurrent item is missed.
+            list(Invoice.objects.select_for_update().filter(pk=self.pk).values_list("pk"))
+            Invoice.objects.filter(pk=self.pk).update(
+                **totals_from_items(), version=models.F("version") + 1)
+        self.refresh_from_db(fields=["total_excl_tax", "total_tax", "total_incl_tax", "version"])
+
+    @staticmethod
+    def allocate_numbers(count):
+        """The next ``count`` invoice numbers after the newest invoice."""
+        # Fall back to cold storage so numbering continues after archival
+        last_invoice = (Invoice.objects.order_by("-id").first()
+                        or ColdInvoice.objects.order_by("-id").first())
+        if last_invoice and last_invoice.invoice_no.startswith("MFES"):
+            first = int(last_invoice.invoice_no.replace("MFES", "")) + 1
+        else:
+            first = 1
+        return [f"MFES{number:05d}" for number in range(first, first + count)]
+
+    def claim_version(self, expected_version):
+        """Compare-and-swap the version, or raise StaleInvoiceError.
+
+        The conditional UPDATE takes the row's write lock, so every edit
+        after this in the same transaction is ordered after any other.
+        """
+        claimed = Invoice.objects.filter(pk=self.pk, version=expected_version).update(
+            version=models.F("version") + 1)
+        if not claimed:
+            raise StaleInvoiceError(self)
 
     def has_goods(self):
         return self.items.filter(product__category__name__iexact="goods").exists()
@@ -98,10 +181,88 @@ class Invoice(models.Model):
 
 class Taxes(models.Model):
     name = models.CharField(max_length=100 , choices=CATEGORY_CHOICES)
+    # Used for dates no TaxRate row covers; see home/taxrates.py
     rate = models.DecimalField(max_digits=5, decimal_places=2)
+
+    def save(self, *args, **kwargs):
+        previous = None
+        if self.pk:
+            previous = Taxes.objects.filter(pk=self.pk).values_list("rate", flat=True).first()
+        super().save(*args, **kwargs)
+        if previous is not None and previous != self.rate:
+            self.record_rate_change(previous)
+
+    def record_rate_change(self, previous):
+        """Keep invoices dated before today on the rate they were billed at."""
+        if not self.rates.exists():
+            TaxRate.objects.create(tax=self, rate=previous, effective_from=RATE_HISTORY_START)
+        TaxRate.objects.update_or_create(
+            tax=self, effective_from=timezone.localdate(), defaults={"rate": self.rate})
+
     def __str__(self):
         return f"{self.name}"
 
+
+RATE_HISTORY_START = datetime.date(2000, 1, 1)
+
+
+class TaxRate(models.Model):
+    """Rate of a tax category from ``effective_from`` until the next row."""
+    tax = models.ForeignKey(Taxes, related_name="rates", on_delete=models.CASCADE)
+    rate = models.DecimalField(max_digits=5, decimal_places=2)
+    effective_from = models.DateField()
+
+    class Meta:
+        ordering = ["tax", "effective_from"]
+        constraints = [
+            # Also the (tax, effective_from) index the rate lookups use
+            models.UniqueConstraint(fields=["tax", "effective_from"], name="unique_tax_rate_date"),
+        ]
+
+    def __str__(self):
+        return f"{self.tax.name} {self.rate}% from {self.effective_from}"
+
+# Line amounts, computed by the database from an item's own columns. The
+# 0.01 factor (rather than dividing by 100) keeps SQLite, which stores
+# whole amounts as integers, from doing integer division. Tax is rounded
+# to paisa when stored, so every total sums the same line values.
+LINE_AMOUNT = models.DecimalField(max_digits=10, decimal_places=2)
+LINE_EXCL_TAX = models.F("price_excl_tax") * models.F("qty")
+LINE_TAX = Round(
+    LINE_EXCL_TAX * models.F("tax_rate") * models.Value(Decimal("0.01")),
+    2, output_field=LINE_AMOUNT,
+)
+LINE_TOTAL = models.ExpressionWrapper(LINE_EXCL_TAX + LINE_TAX, output_field=LINE_AMOUNT)
+
+
+def item_totals():
+    """Aggregates for an invoice's totals from its items.
+
+    Lines are rounded to paisa before summing, as they read back.
+    """
+    return {
+        "total_excl_tax": Sum(models.ExpressionWrapper(LINE_EXCL_TAX, output_field=LINE_AMOUNT)),
+        "total_tax": Sum(Round("tax_amount", 2, output_field=LINE_AMOUNT)),
+        "total_incl_tax": Sum(Round("price_incl_tax", 2, output_field=LINE_AMOUNT)),
+    }
+
+
+def totals_from_items():
+    """Invoice UPDATE values that sum each invoice's items in SQL."""
+    return {
+        name: Coalesce(
+            models.Subquery(
+                InvoiceItem.objects.filter(invoice=models.OuterRef("pk"))
+                .values("invoice")
+                .annotate(total=aggregate)
+                .values("total")
+            ),
+            models.Value(0), output_field=LINE_AMOUNT,
+        )
+        for name, aggregate in item_totals().items()
+    }
+
+
 class InvoiceItem(models.Model):
     invoice = models.ForeignKey(Invoice, related_name="items", on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
@@ -110,16 +271,205 @@ class InvoiceItem(models.Model):
 
     price_excl_tax = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     category = models.ForeignKey(Taxes, on_delete=models.SET_NULL, null=True, blank=True)
-    tax_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
-    price_incl_tax = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    # Rate of the category on the invoice date, fixed when the item is priced
+    tax_rate = models.DecimalField(max_digits=5, decimal_places=2, default=0)
+    tax_amount = models.GeneratedField(
+        expression=LINE_TAX, output_field=LINE_AMOUNT, db_persist=True)
+    price_incl_tax = models.GeneratedField(
+        expression=LINE_TOTAL, output_field=LINE_AMOUNT, db_persist=True)
 
     def save(self, *args, **kwargs):
+        self.apply_pricing()
+        updating = self.pk is not None and not self._state.adding
+        super().save(*args, **kwargs)
+        if updating:
+            # Inserts return the generated amounts; updates do not
+            self.refresh_from_db(fields=["tax_amount", "price_incl_tax"])
+
+    def apply_pricing(self):
+        """Fill in price, category and rate from the product, as of the invoice date.
+
+        Needs no queries once product, category and invoice are loaded, so
+        bulk imports can call it before bulk_create(). The database derives
+        tax_amount and price_incl_tax from these.
+        """
+        from .taxrates import rate_for
         if self.product:
             self.price_excl_tax = self.product.price_excl_tax
             self.category = self.product.category
-        self.tax_amount = (self.price_excl_tax * self.qty) * (self.category.rate / 100)
-        self.price_incl_tax = (self.price_excl_tax * self.qty) + self.tax_amount
-        super().save(*args, **kwargs)
+        self.tax_rate = rate_for(self.category, self.invoice.date)
+
+    def __str__(self):
+        return f"{self.product.name} ({self.qty})"
+
+
+BILL_TYPE_CHOICES = [
+    ("complete", "Complete Bill"),
+    ("goods", "FBR Bill (Goods)"),
+    ("services", "PRA Bill (Services)"),
+]
+
+
+class ArchivedPdf(models.Model):
+    """Final PDF of a paid invoice, stored on disk under its SHA-256."""
+    invoice = models.ForeignKey(Invoice, related_name="archived_pdfs", on_delete=models.CASCADE)
+    bill_type = models.CharField(max_length=20, choices=BILL_TYPE_CHOICES, default="complete")
+    sha256 = models.CharField(max_length=64, db_index=True)
+    size = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["invoice", "bill_type"], name="unique_archived_pdf"),
+        ]
+
+    def __str__(self):
+        return f"{self.invoice.invoice_no} ({self.bill_type})"
+
+
+class ApiToken(models.Model):
+    """Credential for a JSON API client such as a POS terminal.
+
+    Only the SHA-256 of the key is stored; the key itself is shown once,
+    by the create_api_token command.
+    """
+    user = models.ForeignKey("auth.User", related_name="api_tokens", on_delete=models.CASCADE)
+    name = models.CharField(max_length=100)
+    key_digest = models.CharField(max_length=64, unique=True, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @staticmethod
+    def digest(key):
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    @classmethod
+    def issue(cls, user, name):
+        """Create a token and return (token, key)."""
+        key = secrets.token_urlsafe(32)
+        return cls.objects.create(user=user, name=name, key_digest=cls.digest(key)), key
+
+    def __str__(self):
+        return f"{self.name} ({self.user})"
+
+
+class EInvoiceSubmission(models.Model):
+    """Outbox row: one invoice to report to one tax authority.
+
+    Rows are written in the same transaction that marks the invoice paid
+    and are sent later, in batches, by the submit_einvoices worker. The
+    idempotency key travels with every attempt, so a retry after a lost
+    response is recognised by the authority instead of issuing a second
+    number.
+    """
+    AUTHORITY_CHOICES = [
+        ("fbr", "FBR (goods)"),
+        ("pra", "PRA (services)"),
+    ]
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("submitted", "Submitted"),
+        ("not_required", "Not required"),
+        ("failed", "Failed"),
+    ]
+
+    invoice = models.ForeignKey(Invoice, related_name="einvoice_submissions", on_delete=models.CASCADE)
+    authority = models.CharField(max_length=3, choices=AUTHORITY_CHOICES)
+    idempotency_key = models.CharField(max_length=32, unique=True, editable=False)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    attempts = models.PositiveIntegerField(default=0)
+    # Also the lease: a worker pushes this forward while a batch is in flight
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default="")
+    authority_invoice_no = models.CharField(max_length=64, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    submitted_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["invoice", "authority"], name="unique_einvoice_submission"),
+        ]
+        indexes = [
+            models.Index(fields=["status", "authority", "next_attempt_at"], name="einvoice_due"),
+        ]
+
+    def __str__(self):
+        return f"{self.invoice_id} -> {self.authority} ({self.status})"
+
+
+class RequestProfile(models.Model):
+    """Sampled stacks of one request run with ?_profile=1 (see home/profiling.py)."""
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=500)
+    query = models.CharField(max_length=1000, blank=True)
+    user = models.ForeignKey("auth.User", null=True, blank=True, on_delete=models.SET_NULL)
+    status_code = models.PositiveSmallIntegerField()
+    duration_ms = models.FloatField()
+    queries = models.PositiveIntegerField()
+    samples = models.PositiveIntegerField()
+    interval_ms = models.FloatField()
+    # Collapsed stacks: "outer;inner;leaf count" per line
+    stacks = models.TextField()
+    size = models.PositiveIntegerField()
+
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.duration_ms:.0f} ms)"
+
+
+# --- Cold storage (see home/coldstore.py) ---
+
+class ColdInvoice(models.Model):
+    """A closed invoice moved out of the working set, keeping its original id."""
+    id = models.BigIntegerField(primary_key=True)
+    invoice_no = models.CharField(max_length=50, unique=True)
+    date = models.DateTimeField(db_index=True)
+
+    customer = models.ForeignKey(Customer, related_name="cold_invoices", on_delete=models.CASCADE)
+    vehicle = models.ForeignKey(Vehicle, related_name="cold_invoices", on_delete=models.CASCADE)
+
+    status = models.CharField(max_length=20, choices=Invoice.STATUS_CHOICES)
+
+    total_excl_tax = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    total_tax = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    total_incl_tax = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    version = models.PositiveIntegerField(default=1)
+    fbr_invoice_no = models.CharField(max_length=64, blank=True, default="")
+    pra_invoice_no = models.CharField(max_length=64, blank=True, default="")
+    email_status = models.CharField(max_length=20, choices=EMAIL_STATUS_CHOICES, blank=True, default="")
+    emailed_at = models.DateTimeField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "archived invoice"
+
+    def has_goods(self):
+        return self.items.filter(product__category__name__iexact="goods").exists()
+
+    def has_services(self):
+        return self.items.filter(product__category__name__iexact="service").exists()
+
+    def __str__(self):
+        return f"{self.invoice_no} - {self.customer.name}"
+
+
+class ColdInvoiceItem(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    invoice = models.ForeignKey(ColdInvoice, related_name="items", on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, related_name="cold_items", on_delete=models.CASCADE)
+    description = models.CharField(max_length=255, blank=True, null=True)
+    qty = models.IntegerField(default=1)
+
+    price_excl_tax = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    category = models.ForeignKey(Taxes, related_name="cold_items", on_delete=models.SET_NULL, null=True, blank=True)
+    tax_rate = models.DecimalField(max_digits=5, decimal_places=2, default=0)
+    tax_amount = models.GeneratedField(
+        expression=LINE_TAX, output_field=LINE_AMOUNT, db_persist=True)
+    price_incl_tax = models.GeneratedField(
+        expression=LINE_TOTAL, output_field=LINE_AMOUNT, db_persist=True)
+
+    class Meta:
+        verbose_name = "archived invoice item"
 
     def __str__(self):
         return f"{self.product.name} ({self.qty})"
@@ -130,3 +480,71 @@ class InvoiceItem(models.Model):
 @receiver(post_delete, sender=InvoiceItem)
 def update_invoice_totals(sender, instance, **kwargs):
     instance.invoice.update_totals()
+
+
+@receiver(post_save, sender=Invoice)
+@receiver(post_save, sender=InvoiceItem)
+@receiver(post_delete, sender=InvoiceItem)
+def discard_stale_archives(sender, instance, created=False, **kwargs):
+    if sender is Invoice and created:
+        return
+    from .archive import discard_archives
+    discard_archives([instance.pk if sender is Invoice else instance.invoice_id])
+
+
+@receiver(post_save, sender=Invoice)
+def enqueue_einvoice(sender, instance, **kwargs):
+    # Same transaction as the save that finalizes the invoice
+    if instance.status == "paid":
+        from .einvoice import enqueue
+        enqueue([instance.pk])
+
+
+@receiver(post_save, sender=Taxes)
+@receiver(post_save, sender=TaxRate)
+@receiver(post_delete, sender=Taxes)
+@receiver(post_delete, sender=TaxRate)
+def invalidate_tax_rates(sender, instance, **kwargs):
+    from .taxrates import invalidate
+    invalidate()
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_index(sender, instance, **kwargs):
+    from .product_index import invalidate
+    invalidate()
+
+
+@receiver(post_save, sender=Vehicle)
+@receiver(post_delete, sender=Vehicle)
+def invalidate_vehicle_list(sender, instance, **kwargs):
+    from django.core.cache import cache
+    from .lookups import vehicle_list_key
+    # A vehicle moved to another customer lingers in the old list until the TTL
+    cache.delete(vehicle_list_key(instance.customer_id))
+
+
+@receiver(post_save, sender=Vehicle)
+@receiver(post_save, sender=Product)
+def invalidate_invoice_fragments(sender, instance, created=False, **kwargs):
+    # New rows cannot appear in any cached fragment yet, and deleting one
+    # cascades to the invoices that showed it
+    if created:
+        return
+    # Only the invoices that show this row get new fragment keys
+    lookup = {"vehicle": instance} if sender is Vehicle else {"items__product": instance}
+    for model in (Invoice, ColdInvoice):
+        model.objects.filter(**lookup).update(version=models.F("version") + 1)
+
+
+@receiver(post_save, sender=Taxes)
+@receiver(post_save, sender=TaxRate)
+@receiver(post_delete, sender=Taxes)
+@receiver(post_delete, sender=TaxRate)
+def invalidate_all_invoice_fragments(sender, instance, created=False, **kwargs):
+    # A tax edit reaches every invoice's goods/services split
+    if created:
+        return
+    from .fragments import bump_generation
+    bump_generation()
@@ -0,0 +1,127 @@
+"""In-process search index over product names for the admin item lookup.
+
+The whole catalogue is held as a sorted list of lowercased names (for
+prefix matches with bisect) and a trigram -> product ids map (for typo
+tolerant matches). Product edits bump a generation token in the shared
+cache; each process checks it at most every INDEX_CHECK_SECONDS and
+rebuilds when it has changed.
+"""
+import bisect
+import threading
+import time
+from collections import Counter
+
+from django.db import transaction
+
+from .models import Product
+from .utils import generation as tokens
+
+GENERATION_KEY = "product_index:generation"
+INDEX_CHECK_SECONDS = 5
+# Share of the query's trigrams a name must contain; the default of
+# PostgreSQL's pg_trgm word_similarity
+SIMILARITY_THRESHOLD = 0.6
+
+_lock = threading.Lock()
+_index = None
+_generation = None
+_checked_at = 0.0
+
+
+def trigrams(text):
+    """pg_trgm style trigrams: per word, padded with two spaces in front, one after."""
+    grams = set()
+    for word in text.lower().split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class ProductIndex:
+    def __init__(self, products):
+        # products: iterable of (id, name)
+        self.names = {}
+        self.sorted_names = []
+        self.grams = {}
+        self.postings = {}
+        for product_id, name in products:
+            self.names[product_id] = name
+            self.sorted_names.append((name.lower(), product_id))
+            grams = trigrams(name)
+            self.grams[product_id] = len(grams)
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(product_id)
+        self.sorted_names.sort()
+
+    def prefix_matches(self, prefix, limit):
+        start = bisect.bisect_left(self.sorted_names, (prefix,))
+        matches = []
+        for name, product_id in self.sorted_names[start:]:
+            if not name.startswith(prefix) or len(matches) >= limit:
+                break
+            matches.append(product_id)
+        return matches
+
+    def similar(self, query, limit):
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+        shared = Counter()
+        for gram in query_grams:
+            shared.update(self.postings.get(gram, ()))
+        scored = []
+        for product_id, count in shared.items():
+            # How much of the query the name contains, then how close the
+            # whole name is, so "oil" finds "Engine Oil 5W-30" too
+            coverage = count / len(query_grams)
+            if coverage >= SIMILARITY_THRESHOLD:
+                similarity = count / (len(query_grams) + self.grams[product_id] - count)
+                scored.append((-coverage, -similarity, self.names[product_id].lower(), product_id))
+        scored.sort()
+        return [row[-1] for row in scored[:limit]]
+
+    def search(self, query, limit=20):
+        """[(id, name)]: names starting with ``query`` first, then similar names."""
+        query = " ".join(query.lower().split())
+        if not query:
+            return []
+        ids = self.prefix_matches(query, limit)
+        if len(ids) < limit:
+            seen = set(ids)
+            ids += [i for i in self.similar(query, limit) if i not in seen][:limit - len(ids)]
+        return [(product_id, self.names[product_id]) for product_id in ids]
+
+
+def product_index():
+    global _index, _generation, _checked_at
+    now = time.monotonic()
+    # invalidate() may set _index to None at any moment, so read it once
+    index = _index
+    if index is not None and now - _checked_at < INDEX_CHECK_SECONDS:
+        return index
+    with _lock:
+        generation = tokens.current(GENERATION_KEY)
+        index = _index
+        if index is None or generation != _generation:
+            index = ProductIndex(Product.objects.values_list("id", "name").iterator())
+            _index = index
+            _generation = generation
+        _checked_at = now
+    return index
+
+
+def _published():
+    global _index
+    tokens.bump(GENERATION_KEY)
+    _index = None
+
+
+def invalidate():
+    """Drop this process's index and, once the edit commits, tell the other processes to rebuild.
+
+    A bump before the commit would let another process rebuild from the
+    old rows and keep that index under the new token.
+    """
+    global _index
+    _index = None
+    transaction.on_commit(_published)
@@ -0,0 +1,152 @@
+"""Sampling profiler for single requests, turned on with ``?_profile=1``.
+
+While the view runs, a helper thread looks at the request thread's stack
+every PROFILE_SAMPLE_INTERVAL seconds and counts identical stacks. The
+counts are stored in the collapsed "root;caller;callee count" format that
+flame graph tools read, so a sample is wall time: waiting on the
+database shows up under the query that waited.
+
+Stored profiles are kept until they add up to PROFILE_STORAGE_LIMIT
+bytes; beyond that the oldest are deleted.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Sum
+
+from .models import RequestProfile
+
+PARAM = "_profile"
+# Flame graph nodes narrower than this share of the samples are folded
+MIN_NODE_SHARE = 0.005
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    filename = code.co_filename
+    if filename.startswith(str(settings.BASE_DIR)):
+        filename = os.path.relpath(filename, settings.BASE_DIR)
+    else:
+        # site-packages/django/db/... -> django/db/...
+        filename = filename.rsplit("site-packages" + os.sep, 1)[-1]
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+class Sampler:
+    """Count the stacks of one thread from a background thread."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def collapse(stacks):
+    """Collapsed-stack text, heaviest stacks first."""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def call_tree(collapsed):
+    """{"name", "count", "children": [...]} from collapsed-stack text."""
+    root = {"name": "all", "count": 0, "children": {}}
+    for line in collapsed.splitlines():
+        stack, _, count = line.rpartition(" ")
+        count = int(count)
+        root["count"] += count
+        node = root
+        for name in stack.split(";"):
+            node = node["children"].setdefault(name, {"name": name, "count": 0, "children": {}})
+            node["count"] += count
+
+    def finish(node, total):
+        children = [
+            finish(child, total) for child in node["children"].values()
+            if child["count"] >= total * MIN_NODE_SHARE
+        ]
+        children.sort(key=lambda child: -child["count"])
+        return {"name": node["name"], "count": node["count"], "children": children}
+
+    return finish(root, root["count"] or 1)
+
+
+def strip_param(request):
+    """Hide the flag from the view; the admin changelist would take it for a filter."""
+    query = request.GET.copy()
+    query.pop(PARAM, None)
+    request.GET = query
+    request.META["QUERY_STRING"] = query.urlencode()
+
+
+def evict(limit=None):
+    """Delete the oldest profiles until the rest fit in ``limit`` bytes."""
+    limit = settings.PROFILE_STORAGE_LIMIT if limit is None else limit
+    total = RequestProfile.objects.aggregate(total=Sum("size"))["total"] or 0
+    if total <= limit:
+        return 0
+    doomed = []
+    for profile_id, size in RequestProfile.objects.order_by("created_at", "id").values_list("id", "size"):
+        if total <= limit:
+            break
+        doomed.append(profile_id)
+        total -= size
+    RequestProfile.objects.filter(id__in=doomed).delete()
+    return len(doomed)
+
+
+def profile_request(request, get_response):
+    """Run the rest of the request under the sampler and store the result."""
+    strip_param(request)
+    queries = [0]
+
+    def count_queries(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    with Sampler(threading.get_ident(), settings.PROFILE_SAMPLE_INTERVAL) as sampler, \
+            connections["default"].execute_wrapper(count_queries):
+        response = get_response(request)
+    duration = time.perf_counter() - start
+
+    stacks = collapse(sampler.stacks)
+    profile = RequestProfile.objects.create(
+        method=request.method,
+        path=request.path[:500],
+        query=request.META["QUERY_STRING"][:1000],
+        user=request.user if request.user.is_authenticated else None,
+        status_code=response.status_code,
+        duration_ms=round(duration * 1000, 1),
+        queries=queries[0],
+        samples=sum(sampler.stacks.values()),
+        interval_ms=settings.PROFILE_SAMPLE_INTERVAL * 1000,
+        stacks=stacks,
+        size=len(stacks.encode()),
+    )
+    evict()
+    response["X-Profile-Id"] = str(profile.pk)
+    return response
@@ -0,0 +1,104 @@
+import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from itertools import chain
+
+import numpy as np
+from django.db.models import BigIntegerField, F, Value
+from django.db.models.functions import Cast, Coalesce, ExtractMonth, ExtractYear, Round
+
+from .models import InvoiceItem
+
+# Money is handled as integer paisa (1/100 rupee) so sums are exact.
+PAISA_PER_RUPEE = 100
+
+
+def to_paisa(amount):
+    return int((Decimal(amount) * PAISA_PER_RUPEE).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+
+def from_paisa(paisa):
+    return (Decimal(int(paisa)) / PAISA_PER_RUPEE).quantize(Decimal("0.01"))
+
+
+def _paisa(field):
+    return Cast(Round(F(field) * PAISA_PER_RUPEE), BigIntegerField())
+
+
+GROUP_KEYS = {
+    "customer": F("invoice__customer_id"),
+    "month": ExtractYear("invoice__date") * 100 + ExtractMonth("invoice__date"),
+    "category": Coalesce("category_id", Value(0)),
+}
+
+AMOUNT_COLUMNS = {
+    "total_excl_tax": _paisa("price_excl_tax") * F("qty"),
+    "total_tax": _paisa("tax_amount"),
+    "total_incl_tax": _paisa("price_incl_tax"),
+}
+
+
+def _decode_key(name, value):
+    value = int(value)
+    if name == "month":
+        return datetime.date(value // 100, value % 100, 1)
+    if name == "category":
+        return value or None
+    return value
+
+
+def item_columns(queryset, by):
+    """Fetch group keys and paisa amounts as one int64 array, one row per item.
+
+    Conversion to paisa happens in SQL, so no Decimal or model instance is
+    built per item.
+    """
+    annotations = {f"_key_{name}": GROUP_KEYS[name] for name in by}
+    annotations.update({f"_amt_{name}": expr for name, expr in AMOUNT_COLUMNS.items()})
+    rows = (
+        queryset.order_by()
+        .annotate(**annotations)
+        .values_list(*annotations)
+        .iterator(chunk_size=5000)
+    )
+    data = np.fromiter(chain.from_iterable(rows), dtype=np.int64)
+    return data.reshape(-1, len(annotations))
+
+
+def item_totals(queryset=None, by=("customer",)):
+    """Aggregate line item totals grouped by any of customer, month and category.
+
+    Returns a list of dicts sorted by group key, each with the keys in ``by``,
+    an ``items`` count and Decimal ``total_excl_tax``, ``total_tax`` and
+    ``total_incl_tax`` that match summing the Decimal fields item by item.
+    """
+    for name in by:
+        if name not in GROUP_KEYS:
+            raise ValueError(f"Unknown group key: {name}")
+    if queryset is None:
+        queryset = InvoiceItem.objects.all()
+
+    data = item_columns(queryset, by)
+    if not len(data):
+        return []
+
+    keys, amounts = data[:, :len(by)], data[:, len(by):]
+    if by:
+        groups, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+    else:
+        groups, inverse = keys[:1], np.zeros(len(data), dtype=np.int64)
+    order = np.argsort(inverse, kind="stable")
+    sorted_inverse = inverse[order]
+    starts = np.flatnonzero(np.r_[True, sorted_inverse[1:] != sorted_inverse[:-1]])
+    # reduceat over int64 keeps the sums exact, unlike float bincount weights
+    sums = np.add.reduceat(amounts[order], starts, axis=0)
+    counts = np.diff(np.r_[starts, len(order)])
+
+    results = []
+    for group, total, count in zip(groups, sums, counts):
+        row = {name: _decode_key(name, value) for name, value in zip(by, group)}
+        row["items"] = int(count)
+        for name, value in zip(AMOUNT_COLUMNS, total):
+            row[name] = from_paisa(value)
+        results.append(row)
+    return results
@@ -0,0 +1,126 @@
+"""Bring invoice items of open invoices in line with current prices and tax rates.
+
+InvoiceItem.save() copies the product's price, category and dated tax
+rate, but only when an item is saved. Repricing does the same for every
+stale item at once, with UPDATE statements instead of a save() (and a
+full update_totals) per row; the database recomputes the generated line
+amounts. Totals of the touched invoices are then refreshed together.
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import (
+    Count, DecimalField, ExpressionWrapper, F, OuterRef, Q, Subquery, Sum, Value,
+)
+from django.db.models.functions import Coalesce, Round
+
+from .models import Invoice, InvoiceItem, Product, Taxes, totals_from_items
+from .taxrates import rate_on
+
+REPRICE_STATUSES = ("unpaid",)
+BATCH_SIZE = 500
+
+MONEY = DecimalField(max_digits=12, decimal_places=2)
+
+
+def _new_total(price, rate):
+    # Same arithmetic as the generated price_incl_tax column
+    line = price * F("qty")
+    return ExpressionWrapper(
+        line + line * rate * Value(Decimal("0.01")), output_field=MONEY)
+
+
+def stale_items(statuses=REPRICE_STATUSES, products=None, taxes=None):
+    """Items of open invoices whose stored price, category or rate is out of date.
+
+    Each item is annotated with what InvoiceItem.save() would store today
+    (new_price, new_category, new_rate, taking the rate in force on its
+    invoice date) and the resulting new_total.
+    """
+    queryset = InvoiceItem.objects.filter(invoice__status__in=statuses)
+    if products is not None:
+        queryset = queryset.filter(product__in=products)
+    if taxes is not None:
+        queryset = queryset.filter(Q(category__in=taxes) | Q(product__category__in=taxes))
+
+    queryset = queryset.annotate(
+        new_price=F("product__price_excl_tax"),
+        new_category=F("product__category"),
+        new_rate=Coalesce(
+            rate_on(OuterRef("product__category"), OuterRef("invoice__date")),
+            F("product__category__rate"), Value(0), output_field=MONEY,
+        ),
+    ).annotate(
+        new_total=_new_total(F("new_price"), F("new_rate")),
+    )
+    return queryset.filter(
+        ~Q(price_excl_tax=F("new_price"))
+        | ~Q(tax_rate=F("new_rate"))
+        | Q(category__isnull=True, new_category__isnull=False)
+        | Q(category__isnull=False, new_category__isnull=True)
+        | ~Q(category=F("new_category"))
+    )
+
+
+def _cents(expression):
+    # Items are read back rounded to paisa, and update_totals sums those
+    return Round(expression, 2, output_field=MONEY)
+
+
+def impact(items):
+    """Per-invoice effect of repricing ``items``, largest change first."""
+    rows = (
+        items.values("invoice_id", "invoice__invoice_no")
+        .annotate(
+            items=Count("id"),
+            old_total=Sum(_cents("price_incl_tax")),
+            new_total=Sum(_cents("new_total")),
+        )
+        .order_by("invoice_id")
+    )
+    report = []
+    for row in rows:
+        row["change"] = row["new_total"] - row["old_total"]
+        report.append(row)
+    report.sort(key=lambda row: -abs(row["change"]))
+    return report
+
+
+def _reprice_batch(ids):
+    items = InvoiceItem.objects.filter(id__in=ids)
+    product = Product.objects.filter(pk=OuterRef("product_id"))
+    items.update(
+        price_excl_tax=Subquery(product.values("price_excl_tax")[:1]),
+        category=Subquery(product.values("category")[:1]),
+    )
+    # The rate depends on the new category, so it is a second statement
+    invoice_date = Subquery(
+        Invoice.objects.filter(pk=OuterRef(OuterRef("invoice_id"))).values("date")[:1])
+    items.update(tax_rate=Coalesce(
+        rate_on(OuterRef("category_id"), invoice_date),
+        Subquery(Taxes.objects.filter(pk=OuterRef("category_id")).values("rate")[:1]),
+        Value(0), output_field=MONEY,
+    ))
+
+
+def refresh_totals(invoice_ids):
+    """Recompute the totals of the given invoices in a single UPDATE."""
+    return Invoice.objects.filter(id__in=invoice_ids).update(
+        **totals_from_items(), version=F("version") + 1)
+
+
+def reprice(items, batch_size=BATCH_SIZE):
+    """Rewrite ``items`` (from stale_items) and refresh their invoices' totals.
+
+    Returns (items repriced, invoices touched). Runs in one transaction, so
+    an invoice is never left with new item prices and old totals.
+    """
+    with transaction.atomic():
+        rows = list(items.values_list("id", "invoice_id"))
+        ids = [item_id for item_id, _invoice_id in rows]
+        invoice_ids = sorted({invoice_id for _item_id, invoice_id in rows})
+        for start in range(0, len(ids), batch_size):
+            _reprice_batch(ids[start:start + batch_size])
+        for start in range(0, len(invoice_ids), batch_size):
+            refresh_totals(invoice_ids[start:start + batch_size])
+    return len(ids), len(invoice_ids)
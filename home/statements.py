@@ -0,0 +1,85 @@
+import datetime
+from decimal import Decimal
+
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from .models import Customer, Invoice
+
+OUTSTANDING_STATUSES = ("unpaid", "partial")
+
+# (key, label, min age in days, max age in days or None)
+AGING_BUCKETS = [
+    ("age_0_30", "0–30 days", 0, 30),
+    ("age_31_60", "31–60 days", 31, 60),
+    ("age_61_90", "61–90 days", 61, 90),
+    ("age_90_plus", "90+ days", 91, None),
+]
+
+
+def _age_condition(as_of, min_days, max_days):
+    """Invoices dated between max_days and min_days before the as_of day."""
+    day_end = timezone.make_aware(
+        datetime.datetime.combine(as_of + datetime.timedelta(days=1), datetime.time.min))
+    condition = Q(date__lt=day_end - datetime.timedelta(days=min_days))
+    if max_days is not None:
+        condition &= Q(date__gte=day_end - datetime.timedelta(days=max_days + 1))
+    return condition
+
+
+def customer_balances(as_of=None, customer_id=None):
+    """Per-customer totals by status and aging buckets from one grouped query.
+
+    The query groups by (status, customer) so SQLite can walk the covering
+    invoice_status_cust_date index instead of sorting; rows are pivoted into
+    one dict per customer here. Only unpaid and partially paid invoices count
+    towards ``outstanding`` and the aging buckets; ``as_of`` (a date, default
+    today) is the day ages are measured from.
+    """
+    as_of = as_of or timezone.localdate()
+    aggregates = {"invoices": Count("id"), "total": Sum("total_incl_tax")}
+    for key, _label, min_days, max_days in AGING_BUCKETS:
+        aggregates[key] = Sum(
+            "total_incl_tax", filter=_age_condition(as_of, min_days, max_days))
+
+    qs = Invoice.objects.all()
+    if customer_id is not None:
+        qs = qs.filter(customer_id=customer_id)
+    grouped = qs.values("status", "customer_id").annotate(**aggregates).order_by()
+
+    zero = Decimal("0.00")
+    balances = {}
+    for group in grouped:
+        row = balances.get(group["customer_id"])
+        if row is None:
+            row = balances[group["customer_id"]] = {
+                "customer_id": group["customer_id"],
+                "invoices": 0,
+                "paid": zero, "partial": zero, "unpaid": zero, "outstanding": zero,
+                **{key: zero for key, *_ in AGING_BUCKETS},
+            }
+        row["invoices"] += group["invoices"]
+        row[group["status"]] = row.get(group["status"], zero) + (group["total"] or zero)
+        if group["status"] in OUTSTANDING_STATUSES:
+            row["outstanding"] += group["total"] or zero
+            for key, *_ in AGING_BUCKETS:
+                row[key] += group[key] or zero
+
+    names = dict(Customer.objects.filter(id__in=balances).values_list("id", "name"))
+    for row in balances.values():
+        row["customer__name"] = names.get(row["customer_id"], "")
+    return sorted(
+        balances.values(), key=lambda row: (-row["outstanding"], row["customer__name"]))
+
+
+def customer_open_invoices(customer_id, as_of=None):
+    """Drill-down: one customer's outstanding invoices with their age in days."""
+    as_of = as_of or timezone.localdate()
+    rows = list(
+        Invoice.objects.filter(customer_id=customer_id, status__in=OUTSTANDING_STATUSES)
+        .order_by("date")
+        .values("id", "invoice_no", "date", "status", "total_incl_tax", "vehicle__number")
+    )
+    for row in rows:
+        row["age_days"] = (as_of - timezone.localtime(row["date"]).date()).days
+    return rows
@@ -0,0 +1,103 @@
+// Hide button in print
+const style = document.createElement("style");
+style.innerHTML = `@media print { #download-pdf-btn, #back-admin-btn { display: none !important; } }`;
+document.head.appendChild(style);
+
+const ROWS_PER_PAGE = 18;
+
+function paginateBillReport() {
+  const pageContainer = document.getElementById("billreport-content");
+  const firstPage = document.getElementById("billreport-page-1");
+  const header = document.getElementById("billreport-header");
+  const table = document.getElementById("billreport-table");
+  const footer = document.getElementById("billreport-footer");
+  if (!pageContainer || !firstPage || !table) return;
+
+  const rows = Array.from(table.querySelectorAll("tbody tr"));
+  if (rows.length === 0) return;
+
+  const thead = table.querySelector("thead");
+  const tfoot = table.querySelector("tfoot");
+  const theadHtml = thead ? thead.outerHTML : "";
+  const tfootHtml = tfoot ? tfoot.outerHTML : "";
+
+  const chunks = [];
+  for (let i = 0; i < rows.length; i += ROWS_PER_PAGE) {
+    chunks.push(rows.slice(i, i + ROWS_PER_PAGE));
+  }
+
+  const tbody = table.querySelector("tbody");
+  tbody.innerHTML = "";
+  chunks[0].forEach((row) => tbody.appendChild(row));
+
+  if (chunks.length > 1 && tfoot) {
+    tfoot.remove();
+  }
+
+  for (let i = 1; i < chunks.length; i++) {
+    const isLast = i === chunks.length - 1;
+    const page = document.createElement("div");
+    page.className = "invoice-a4 invoice-page";
+
+    if (header) {
+      const headerClone = header.cloneNode(true);
+      headerClone.removeAttribute("id");
+      page.appendChild(headerClone);
+    }
+
+    const pageTable = document.createElement("table");
+    pageTable.className = "bill-table";
+    pageTable.innerHTML = `${theadHtml}<tbody></tbody>${
+      isLast ? tfootHtml : ""
+    }`;
+    const pageTbody = pageTable.querySelector("tbody");
+    chunks[i].forEach((row) => pageTbody.appendChild(row));
+    page.appendChild(pageTable);
+
+    if (footer) {
+      const footerClone = footer.cloneNode(true);
+      footerClone.removeAttribute("id");
+      page.appendChild(footerClone);
+    }
+
+    pageContainer.appendChild(page);
+  }
+}
+
+if (document.readyState === "loading") {
+  document.addEventListener("DOMContentLoaded", paginateBillReport);
+} else {
+  paginateBillReport();
+}
+// Download PDF button handler
+document
+  .getElementById("download-pdf-btn")
+  .addEventListener("click", function () {
+    // Use current date for filename
+    const now = new Date();
+    const y = now.getFullYear();
+    const m = String(now.getMonth() + 1).padStart(2, "0");
+    const d = String(now.getDate()).padStart(2, "0");
+    let filename = `BillReport_${y}${m}${d}.pdf`;
+    // Hide the button before generating PDF
+    const btn = document.getElementById("download-pdf-btn");
+    btn.style.display = "none";
+    const backBtn = document.getElementById("back-admin-btn");
+    backBtn.style.display = "none";
+    // Generate PDF
+    html2pdf()
+      .set({
+        margin: [12, 10, 18, 10],
+        filename: filename,
+        image: { type: "jpeg", quality: 0.85 },
+        html2canvas: { scale: 2, useCORS: true },
+        jsPDF: { unit: "mm", format: "a4", orientation: "portrait", compress: true },
+        pagebreak: { mode: ["avoid-all", "css", "legacy"] },
+      })
+      .from(document.getElementById("billreport-content"))
+      .save()
+      .then(() => {
+        btn.style.display = "";
+        backBtn.style.display = "";
+      });
+  });
@@ -1,3 +1,2 @@
 /*! For license information please see html2pdf.bundle.min.js.LICENSE.txt */
 !function(e,t){"object"==typeof exports&&"object"==typeof module?module.exports=t():"function"==typeof define&&define.amd?define("html2pdf",[],t):"object"==typeof exports?exports.html2pdf=t():e.html2pdf=t()}(self,(function(){return function(){var e,t,r={"./node_modules/@babel/runtime-corejs3/core-js-stable/array/from.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/array/from.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/array/is-array.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/array/is-array.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/date/now.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/date/now.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/instance/bind.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/instance/bind.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/instance/concat.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/instance/concat.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/instance/every.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/instance/every.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/instance/fill.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/instance/fill.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/instance/filter.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/instance/filter.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/instance/for-each.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/instance/for-each.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/instance/includes.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/instance/includes.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/instance/index-of.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/instance/index-of.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/instance/map.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/instance/map.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/instance/reduce.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/instance/reduce.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/instance/reverse.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/instance/reverse.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/instance/slice.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/instance/slice.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/instance/some.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/instance/some.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/instance/starts-with.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/instance/starts-with.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/instance/trim.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/instance/trim.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/instance/values.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/instance/values.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/map.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/map/index.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/object/define-properties.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/object/define-properties.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/object/define-property.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/object/define-property.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/object/get-own-property-descriptor.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/object/get-own-property-descriptor.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/object/get-own-property-descriptors.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/object/get-own-property-descriptors.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/object/get-own-property-symbols.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/object/get-own-property-symbols.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/object/keys.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/object/keys.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/parse-float.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/parse-float.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/parse-int.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/parse-int.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/promise.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/promise/index.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/reflect/apply.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/reflect/apply.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/reflect/construct.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/reflect/construct.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/reflect/delete-property.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/reflect/delete-property.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/reflect/get-prototype-of.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/reflect/get-prototype-of.js")},"./node_modules/@babel/runtime-corejs3/core-js-stable/symbol.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/stable/symbol/index.js")},"./node_modules/@babel/runtime-corejs3/core-js/array/from.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/features/array/from.js")},"./node_modules/@babel/runtime-corejs3/core-js/array/is-array.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/features/array/is-array.js")},"./node_modules/@babel/runtime-corejs3/core-js/get-iterator-method.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/features/get-iterator-method.js")},"./node_modules/@babel/runtime-corejs3/core-js/get-iterator.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/features/get-iterator.js")},"./node_modules/@babel/runtime-corejs3/core-js/instance/slice.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/features/instance/slice.js")},"./node_modules/@babel/runtime-corejs3/core-js/object/create.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/features/object/create.js")},"./node_modules/@babel/runtime-corejs3/core-js/object/define-property.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/features/object/define-property.js")},"./node_modules/@babel/runtime-corejs3/core-js/object/get-own-property-descriptor.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/features/object/get-own-property-descriptor.js")},"./node_modules/@babel/runtime-corejs3/core-js/object/get-prototype-of.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/features/object/get-prototype-of.js")},"./node_modules/@babel/runtime-corejs3/core-js/object/set-prototype-of.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/features/object/set-prototype-of.js")},"./node_modules/@babel/runtime-corejs3/core-js/promise.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/features/promise/index.js")},"./node_modules/@babel/runtime-corejs3/core-js/reflect/get.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/features/reflect/get.js")},"./node_modules/@babel/runtime-corejs3/core-js/symbol.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/features/symbol/index.js")},"./node_modules/@babel/runtime-corejs3/core-js/symbol/iterator.js":function(e,t,r){e.exports=r("./node_modules/core-js-pure/features/symbol/iterator.js")},"./node_modules/@babel/runtime-corejs3/helpers/esm/arrayLikeToArray.js":function(e,t,r){"use strict";function n(e,t){(null==t||t>e.length)&&(t=e.length);for(var r=0,n=new Array(t);r<t;r++)n[r]=e[r];return n}r.r(t),r.d(t,{default:function(){return n}})},"./node_modules/@babel/runtime-corejs3/helpers/esm/arrayWithHoles.js":function(e,t,r){"use strict";r.r(t),r.d(t,{default:function(){return o}});var n=r("./node_modules/@babel/runtime-corejs3/core-js/array/is-array.js");function o(e){if(n(e))return e}},"./node_modules/@babel/runtime-corejs3/helpers/esm/arrayWithoutHoles.js":function(e,t,r){"use strict";r.r(t),r.d(t,{default:function(){return s}});var n=r("./node_modules/@babel/runtime-corejs3/core-js/array/is-array.js"),o=r("./node_modules/@babel/runtime-corejs3/helpers/esm/arrayLikeToArray.js");function s(e){if(n(e))return(0,o.default)(e)}},"./node_modules/@babel/runtime-corejs3/helpers/esm/assertThisInitialized.js":function(e,t,r){"use strict";function n(e){if(void 0===e)throw new ReferenceError("this hasn't been initialised - super() hasn't been called");return e}r.r(t),r.d(t,{default:function(){return n}})},"./node_modules/@babel/runtime-corejs3/helpers/esm/asyncToGenerator.js":function(e,t,r){"use strict";r.r(t),r.d(t,{default:function(){return s}});var n=r("./node_modules/@babel/runtime-corejs3/core-js/promise.js");function o(e,t,r,o,s,i,a){try{var A=e[i](a),u=A.value}catch(e){return void r(e)}A.done?t(u):n.resolve(u).then(o,s)}function s(e){return function(){var t=this,r=arguments;return new n((function(n,s){var i=e.apply(t,r);function a(e){o(i,n,s,a,A,"next",e)}function A(e){o(i,n,s,a,A,"throw",e)}a(void 0)}))}}},"./node_modules/@babel/runtime-corejs3/helpers/esm/classCallCheck.js":function(e,t,r){"use strict";function n(e,t){if(!(e instanceof t))throw new TypeError("Cannot call a class as a function")}r.r(t),r.d(t,{default:function(){return n}})},"./node_modules/@babel/runtime-corejs3/helpers/esm/createClass.js":function(e,t,r){"use strict";r.r(t),r.d(t,{default:function(){return s}});var n=r("./node_modules/@babel/runtime-corejs3/core-js/object/define-property.js");function o(e,t){for(var r=0;r<t.length;r++){var o=t[r];o.enumerable=o.enumerable||!1,o.configurable=!0,"value"in o&&(o.writable=!0),n(e,o.key,o)}}function s(e,t,r){return t&&o(e.prototype,t),r&&o(e,r),e}},"./node_modules/@babel/runtime-corejs3/helpers/esm/defineProperty.js":function(e,t,r){"use strict";r.r(t),r.d(t,{default:function(){return o}});var n=r("./node_modules/@babel/runtime-corejs3/core-js/object/define-property.js");function o(e,t,r){return t in e?n(e,t,{value:r,enumerable:!0,configurable:!0,writable:!0}):e[t]=r,e}},"./node_modules/@babel/runtime-corejs3/helpers/esm/get.js":function(e,t,r){"use strict";r.r(t),r.d(t,{default:function(){return i}});var n=r("./node_modules/@babel/runtime-corejs3/core-js/reflect/get.js"),o=r("./node_modules/@babel/runtime-corejs3/core-js/object/get-own-property-descriptor.js"),s=r("./node_modules/@babel/runtime-corejs3/helpers/esm/superPropBase.js");function i(e,t,r){return(i="undefined"!=typeof Reflect&&n?n:function(e,t,r){var n=(0,s.default)(e,t);if(n){var i=o(n,t);return i.get?i.get.call(r):i.value}})(e,t,r||e)}},"./node_modules/@babel/runtime-corejs3/helpers/esm/getPrototypeOf.js":function(e,t,r){"use strict";r.r(t),r.d(t,{default:function(){return s}});var n=r("./node_modules/@babel/runtime-corejs3/core-js/object/set-prototype-of.js"),o=r("./node_modules/@babel/runtime-corejs3/core-js/object/get-prototype-of.js");function s(e){return(s=n?o:function(e){return e.__proto__||o(e)})(e)}},"./node_modules/@babel/runtime-corejs3/helpers/esm/inherits.js":function(e,t,r){"use strict";r.r(t),r.d(t,{default:function(){return s}});var n=r("./node_modules/@babel/runtime-corejs3/core-js/object/create.js"),o=r("./node_modules/@babel/runtime-corejs3/helpers/esm/setPrototypeOf.js");function s(e,t){if("function"!=typeof t&&null!==t)throw new TypeError("Super expression must either be null or a function");e.prototype=n(t&&t.prototype,{constructor:{value:e,writable:!0,configurable:!0}}),t&&(0,o.default)(e,t)}},"./node_modules/@babel/runtime-corejs3/helpers/esm/iterableToArray.js":function(e,t,r){"use strict";r.r(t),r.d(t,{default:function(){return i}});var n=r("./node_modules/@babel/runtime-corejs3/core-js/symbol.js"),o=r("./node_modules/@babel/runtime-corejs3/core-js/get-iterator-method.js"),s=r("./node_modules/@babel/runtime-corejs3/core-js/array/from.js");function i(e){if(void 0!==n&&null!=o(e)||null!=e["@@iterator"])return s(e)}},"./node_modules/@babel/runtime-corejs3/helpers/esm/iterableToArrayLimit.js":function(e,t,r){"use strict";r.r(t),r.d(t,{default:function(){return s}});var n=r("./node_modules/@babel/runtime-corejs3/core-js/symbol.js"),o=r("./node_modules/@babel/runtime-corejs3/core-js/get-iterator-method.js");function s(e,t){var r=null==e?null:void 0!==n&&o(e)||e["@@iterator"];if(null!=r){var s,i,a=[],A=!0,u=!1;try{for(r=r.call(e);!(A=(s=r.next()).done)&&(a.push(s.value),!t||a.length!==t);A=!0);}catch(e){u=!0,i=e}finally{try{A||null==r.return||r.return()}finally{if(u)throw i}}return a}}},"./node_modules/@babel/runtime-corejs3/helpers/esm/nonIterableRest.js":function(e,t,r){"use strict";function n(){throw new TypeError("Invalid attempt to destructure non-iterable instance.\nIn order to be iterable, non-array objects must have a [Symbol.iterator]() method.")}r.r(t),r.d(t,{default:function(){return n}})},"./node_modules/@babel/runtime-corejs3/helpers/esm/nonIterableSpread.js":function(e,t,r){"use strict";function n(){throw new TypeError("Invalid attempt to spread non-iterable instance.\nIn order to be iterable, non-array objects must have a [Symbol.iterator]() method.")}r.r(t),r.d(t,{default:function(){return n}})},"./node_modules/@babel/runtime-corejs3/helpers/esm/possibleConstructorReturn.js":function(e,t,r){"use strict";r.r(t),r.d(t,{default:function(){return s}});var n=r("./node_modules/@babel/runtime-corejs3/helpers/esm/typeof.js"),o=r("./node_modules/@babel/runtime-corejs3/helpers/esm/assertThisInitialized.js");function s(e,t){return!t||"object"!==(0,n.default)(t)&&"function"!=typeof t?(0,o.default)(e):t}},"./node_modules/@babel/runtime-corejs3/helpers/esm/setPrototypeOf.js":function(e,t,r){"use strict";r.r(t),r.d(t,{default:function(){return o}});var n=r("./node_modules/@babel/runtime-corejs3/core-js/object/set-prototype-of.js");function o(e,t){return(o=n||function(e,t){return e.__proto__=t,e})(e,t)}},"./node_modules/@babel/runtime-corejs3/helpers/esm/slicedToArray.js":function(e,t,r){"use strict";r.r(t),r.d(t,{default:function(){return a}});var n=r("./node_modules/@babel/runtime-corejs3/helpers/esm/arrayWithHoles.js"),o=r("./node_modules/@babel/runtime-corejs3/helpers/esm/iterableToArrayLimit.js"),s=r("./node_modules/@babel/runtime-corejs3/helpers/esm/unsupportedIterableToArray.js"),i=r("./node_modules/@babel/runtime-corejs3/helpers/esm/nonIterableRest.js");function a(e,t){return(0,n.default)(e)||(0,o.default)(e,t)||(0,s.default)(e,t)||(0,i.default)()}},"./node_modules/@babel/runtime-corejs3/helpers/esm/superPropBase.js":function(e,t,r){"use strict";r.r(t),r.d(t,{default:function(){return o}});var n=r("./node_modules/@babel/runtime-corejs3/helpers/esm/getPrototypeOf.js");function o(e,t){for(;!Object.prototype.hasOwnProperty.call(e,t)&&null!==(e=(0,n.default)(e)););return e}},"./node_modules/@babel/runtime-corejs3/helpers/esm/toConsumableArray.js":function(e,t,r){"use strict";r.r(t),r.d(t,{default:function(){return a}});var n=r("./node_modules/@babel/runtime-corejs3/helpers/esm/arrayWithoutHoles.js"),o=r("./node_modules/@babel/runtime-corejs3/helpers/esm/iterableToArray.js"),s=r("./node_modules/@babel/runtime-corejs3/helpers/esm/unsupportedIterableToArray.js"),i=r("./node_modules/@babel/runtime-corejs3/helpers/esm/nonIterableSpread.js");function a(e){return(0,n.default)(e)||(0,o.default)(e)||(0,s.default)(e)||(0,i.default)()}},"./node_modules/@babel/runtime-corejs3/helpers/esm/typeof.js":function(e,t,r){"use strict";r.r(t),r.d(t,{default:function(){return s}});var n=r("./node_modules/@babel/runtime-corejs3/core-js/symbol.js"),o=r("./node_modules/@babel/runtime-corejs3/core-js/symbol/iterator.js");function s(e){return(s="function"==typeof n&&"symbol"==typeof o?function(e){return typeof e}:function(e){return e&&"function"==typeof n&&e.constructor===n&&e!==n.prototype?"symbol":typeof e})(e)}},"./node_modules/@babel/runtime-corejs3/helpers/esm/unsupportedIterableToArray.js":function(e,t,r){"use strict";r.r(t),r.d(t,{default:function(){return i}});var n=r("./node_modules/@babel/runtime-corejs3/core-js/instance/slice.js"),o=r("./node_modules/@babel/runtime-corejs3/core-js/array/from.js"),s=r("./node_modules/@babel/runtime-corejs3/helpers/esm/arrayLikeToArray.js");function i(e,t){var r;if(e){if("string"==typeof e)return(0,s.default)(e,t);var i=n(r=Object.prototype.toString.call(e)).call(r,8,-1);return"Object"===i&&e.constructor&&(i=e.constructor.name),"Map"===i||"Set"===i?o(e):"Arguments"===i||/^(?:Ui|I)nt(?:8|16|32)(?:Clamped)?Array$/.test(i)?(0,s.default)(e,t):void 0}}},"./node_modules/@babel/runtime-corejs3/regenerator/index.js":function(e,t,r){e.exports=r("./node_modules/regenerator-runtime/runtime.js")},"./src/plugin/hyperlinks.js":function(e,t,r){"use strict";r.r(t),r("./node_modules/core-js/modules/web.dom-collections.for-each.js"),r("./node_modules/core-js/modules/es.string.link.js");var n=r("./src/worker.js"),o=r("./src/utils.js"),s=[],i={toContainer:n.default.prototype.toContainer,toPdf:n.default.prototype.toPdf};n.default.prototype.toContainer=function(){return i.toContainer.call(this).then((function(){if(this.opt.enableLinks){var e=this.prop.container,t=e.querySelectorAll("a"),r=(0,o.unitConvert)(e.getBoundingClientRect(),this.prop.pageSize.k);s=[],Array.prototype.forEach.call(t,(function(e){for(var t=e.getClientRects(),n=0;n<t.length;n++){var i=(0,o.unitConvert)(t[n],this.prop.pageSize.k);i.left-=r.left,i.top-=r.top;var a=Math.floor(i.top/this.prop.pageSize.inner.height)+1,A=this.opt.margin[0]+i.top%this.prop.pageSize.inner.height,u=this.opt.margin[1]+i.left;s.push({page:a,top:A,left:u,clientRect:i,link:e})}}),this)}}))},n.default.prototype.toPdf=function(){return i.toPdf.call(this).then((function(){if(this.opt.enableLinks){s.forEach((function(e){this.prop.pdf.setPage(e.page),this.prop.pdf.link(e.left,e.top,e.clientRect.width,e.clientRect.height,{url:e.link.href})}),this);var e=this.prop.pdf.internal.getNumberOfPages();this.prop.pdf.setPage(e)}}))}},"./src/plugin/jspdf-plugin.js":function(e,t,r){"use strict";r.r(t),r("./node_modules/core-js/modules/es.symbol.js"),r("./node_modules/core-js/modules/es.symbol.description.js"),r("./node_modules/core-js/modules/es.object.to-string.js"),r("./node_modules/core-js/modules/es.symbol.iterator.js"),r("./node_modules/core-js/modules/es.array.iterator.js"),r("./node_modules/core-js/modules/es.string.iterator.js"),r("./node_modules/core-js/modules/web.dom-collections.iterator.js");var n=r("./node_modules/jspdf/dist/jspdf.es.min.js");function o(e){return(o="function"==typeof Symbol&&"symbol"==typeof Symbol.iterator?function(e){return typeof e}:function(e){return e&&"function"==typeof Symbol&&e.constructor===Symbol&&e!==Symbol.prototype?"symbol":typeof e})(e)}n.jsPDF.getPageSize=function(e,t,r){if("object"===o(e)){var n=e;e=n.orientation,t=n.unit||t,r=n.format||r}t=t||"mm",r=r||"a4",e=(""+(e||"P")).toLowerCase();var s=(""+r).toLowerCase(),i={a0:[2383.94,3370.39],a1:[1683.78,2383.94],a2:[1190.55,1683.78],a3:[841.89,1190.55],a4:[595.28,841.89],a5:[419.53,595.28],a6:[297.64,419.53],a7:[209.76,297.64],a8:[147.4,209.76],a9:[104.88,147.4],a10:[73.7,104.88],b0:[2834.65,4008.19],b1:[2004.09,2834.65],b2:[1417.32,2004.09],b3:[1000.63,1417.32],b4:[708.66,1000.63],b5:[498.9,708.66],b6:[354.33,498.9],b7:[249.45,354.33],b8:[175.75,249.45],b9:[124.72,175.75],b10:[87.87,124.72],c0:[2599.37,3676.54],c1:[1836.85,2599.37],c2:[1298.27,1836.85],c3:[918.43,1298.27],c4:[649.13,918.43],c5:[459.21,649.13],c6:[323.15,459.21],c7:[229.61,323.15],c8:[161.57,229.61],c9:[113.39,161.57],c10:[79.37,113.39],dl:[311.81,623.62],letter:[612,792],"government-letter":[576,756],legal:[612,1008],"junior-legal":[576,360],ledger:[1224,792],tabloid:[792,1224],"credit-card":[153,243]};switch(t){case"pt":var a=1;break;case"mm":a=72/25.4;break;case"cm":a=72/2.54;break;case"in":a=72;break;case"px":a=.75;break;case"pc":case"em":a=12;break;case"ex":a=6;break;default:throw"Invalid unit: "+t}if(i.hasOwnProperty(s))var A=i[s][1]/a,u=i[s][0]/a;else try{A=r[1],u=r[0]}catch(e){throw new Error("Invalid format: "+r)}if("p"===e||"portrait"===e){if(e="p",u>A){var c=u;u=A,A=c}}else{if("l"!==e&&"landscape"!==e)throw"Invalid orientation: "+e;e="l",A>u&&(c=u,u=A,A=c)}return{width:u,height:A,unit:t,k:a}},t.default=n.jsPDF},"./src/plugin/pagebreaks.js":function(e,t,r){"use strict";r.r(t),r("./node_modules/core-js/modules/es.array.concat.js"),r("./node_modules/core-js/modules/es.array.slice.js"),r("./node_modules/core-js/modules/es.array.join.js"),r("./node_modules/core-js/modules/web.dom-collections.for-each.js"),r("./node_modules/core-js/modules/es.object.keys.js");var n=r("./src/worker.js"),o=r("./src/utils.js"),s={toContainer:n.default.prototype.toContainer};n.default.template.opt.pagebreak={mode:["css","legacy"],before:[],after:[],avoid:[]},n.default.prototype.toContainer=function(){return s.toContainer.call(this).then((function(){var e=this.prop.container,t=this.prop.pageSize.inner.px.height,r=[].concat(this.opt.pagebreak.mode),n={avoidAll:-1!==r.indexOf("avoid-all"),css:-1!==r.indexOf("css"),legacy:-1!==r.indexOf("legacy")},s={},i=this;["before","after","avoid"].forEach((function(t){var r=n.avoidAll&&"avoid"===t;s[t]=r?[]:[].concat(i.opt.pagebreak[t]||[]),s[t].length>0&&(s[t]=Array.prototype.slice.call(e.querySelectorAll(s[t].join(", "))))}));var a=e.querySelectorAll(".html2pdf__page-break");a=Array.prototype.slice.call(a);var A=e.querySelectorAll("*");Array.prototype.forEach.call(A,(function(e){var r={before:!1,after:n.legacy&&-1!==a.indexOf(e),avoid:n.avoidAll};if(n.css){var i=window.getComputedStyle(e),A=["always","page","left","right"];r={before:r.before||-1!==A.indexOf(i.breakBefore||i.pageBreakBefore),after:r.after||-1!==A.indexOf(i.breakAfter||i.pageBreakAfter),avoid:r.avoid||-1!==["avoid","avoid-page"].indexOf(i.breakInside||i.pageBreakInside)}}Object.keys(r).forEach((function(t){r[t]=r[t]||-1!==s[t].indexOf(e)}));var u=e.getBoundingClientRect();if(r.avoid&&!r.before){var c=Math.floor(u.top/t),l=Math.floor(u.bottom/t),d=Math.abs(u.bottom-u.top)/t;l!==c&&d<=1&&(r.before=!0)}if(r.before){var f=(0,o.createElement)("div",{style:{display:"block",height:t-u.top%t+"px"}});e.parentNode.insertBefore(f,e)}r.after&&(f=(0,o.createElement)("div",{style:{display:"block",height:t-u.bottom%t+"px"}}),e.parentNode.insertBefore(f,e.nextSibling))}))}))}},"./src/utils.js":function(e,t,r){"use strict";function n(e){return(n="function"==typeof Symbol&&"symbol"==typeof Symbol.iterator?function(e){return typeof e}:function(e){return e&&"function"==typeof Symbol&&e.constructor===Symbol&&e!==Symbol.prototype?"symbol":typeof e})(e)}r.r(t),r.d(t,{objType:function(){return o},createElement:function(){return s},cloneNode:function(){return i},unitConvert:function(){return a},toPx:function(){return A}}),r("./node_modules/core-js/modules/es.number.constructor.js"),r("./node_modules/core-js/modules/es.symbol.js"),r("./node_modules/core-js/modules/es.symbol.description.js"),r("./node_modules/core-js/modules/es.object.to-string.js"),r("./node_modules/core-js/modules/es.symbol.iterator.js"),r("./node_modules/core-js/modules/es.array.iterator.js"),r("./node_modules/core-js/modules/es.string.iterator.js"),r("./node_modules/core-js/modules/web.dom-collections.iterator.js");var o=function(e){var t=n(e);return"undefined"===t?"undefined":"string"===t||e instanceof String?"string":"number"===t||e instanceof Number?"number":"function"===t||e instanceof Function?"function":e&&e.constructor===Array?"array":e&&1===e.nodeType?"element":"object"===t?"object":"unknown"},s=function(e,t){var r=document.createElement(e);if(t.className&&(r.className=t.className),t.innerHTML){r.innerHTML=t.innerHTML;for(var n=r.getElementsByTagName("script"),o=n.length;o-- >0;null)n[o].parentNode.removeChild(n[o])}for(var s in t.style)r.style[s]=t.style[s];return r},i=function e(t,r){for(var n=3===t.nodeType?document.createTextNode(t.nodeValue):t.cloneNode(!1),o=t.firstChild;o;o=o.nextSibling)!0!==r&&1===o.nodeType&&"SCRIPT"===o.nodeName||n.appendChild(e(o,r));return 1===t.nodeType&&("CANVAS"===t.nodeName?(n.width=t.width,n.height=t.height,n.getContext("2d").drawImage(t,0,0)):"TEXTAREA"!==t.nodeName&&"SELECT"!==t.nodeName||(n.value=t.value),n.addEventListener("load",(function(){n.scrollTop=t.scrollTop,n.scrollLeft=t.scrollLeft}),!0)),n},a=function(e,t){if("number"===o(e))return 72*e/96/t;var r={};for(var n in e)r[n]=72*e[n]/96/t;return r},A=function(e,t){return Math.floor(e*t/72*96)}},"./src/worker.js":function(e,t,r){"use strict";r.r(t),r("./node_modules/core-js/modules/es.object.assign.js"),r("./node_modules/core-js/modules/es.array.map.js"),r("./node_modules/core-js/modules/es.object.keys.js"),r("./node_modules/core-js/modules/es.array.concat.js"),r("./node_modules/core-js/modules/es.object.to-string.js"),r("./node_modules/core-js/modules/es.regexp.to-string.js"),r("./node_modules/core-js/modules/es.function.name.js"),r("./node_modules/core-js/modules/web.dom-collections.for-each.js");var n=r("./node_modules/jspdf/dist/jspdf.es.min.js"),o=r("./node_modules/html2canvas/dist/html2canvas.js"),s=r("./src/utils.js"),i=r("./node_modules/es6-promise/dist/es6-promise.js"),a=r.n(i)().Promise,A=function e(t){var r=Object.assign(e.convert(a.resolve()),JSON.parse(JSON.stringify(e.template))),n=e.convert(a.resolve(),r);return(n=n.setProgress(1,e,1,[e])).set(t)};(A.prototype=Object.create(a.prototype)).constructor=A,A.convert=function(e,t){return e.__proto__=t||A.prototype,e},A.template={prop:{src:null,container:null,overlay:null,canvas:null,img:null,pdf:null,pageSize:null},progress:{val:0,state:null,n:0,stack:[]},opt:{filename:"file.pdf",margin:[0,0,0,0],image:{type:"jpeg",quality:.95},enableLinks:!0,html2canvas:{},jsPDF:{}}},A.prototype.from=function(e,t){return this.then((function(){switch(t=t||function(e){switch((0,s.objType)(e)){case"string":return"string";case"element":return"canvas"===e.nodeName.toLowerCase?"canvas":"element";default:return"unknown"}}(e)){case"string":return this.set({src:(0,s.createElement)("div",{innerHTML:e})});case"element":return this.set({src:e});case"canvas":return this.set({canvas:e});case"img":return this.set({img:e});default:return this.error("Unknown source type.")}}))},A.prototype.to=function(e){switch(e){case"container":return this.toContainer();case"canvas":return this.toCanvas();case"img":return this.toImg();case"pdf":return this.toPdf();default:return this.error("Invalid target.")}},A.prototype.toContainer=function(){return this.thenList([function(){return this.prop.src||this.error("Cannot duplicate - no source HTML.")},function(){return this.prop.pageSize||this.setPageSize()}]).then((function(){var e={position:"fixed",overflow:"hidden",zIndex:1e3,left:0,right:0,bottom:0,top:0,backgroundColor:"rgba(0,0,0,0.8)"},t={position:"absolute",width:this.prop.pageSize.inner.width+this.prop.pageSize.unit,left:0,right:0,top:0,height:"auto",margin:"auto",backgroundColor:"white"};e.opacity=0;var r=(0,s.cloneNode)(this.prop.src,this.opt.html2canvas.javascriptEnabled);this.prop.overlay=(0,s.createElement)("div",{className:"html2pdf__overlay",style:e}),this.prop.container=(0,s.createElement)("div",{className:"html2pdf__container",style:t}),this.prop.container.appendChild(r),this.prop.overlay.appendChild(this.prop.container),document.body.appendChild(this.prop.overlay)}))},A.prototype.toCanvas=function(){var e=[function(){return document.body.contains(this.prop.container)||this.toContainer()}];return this.thenList(e).then((function(){var e=Object.assign({},this.opt.html2canvas);return delete e.onrendered,o(this.prop.container,e)})).then((function(e){(this.opt.html2canvas.onrendered||function(){})(e),this.prop.canvas=e,document.body.removeChild(this.prop.overlay)}))},A.prototype.toImg=function(){return this.thenList([function(){return this.prop.canvas||this.toCanvas()}]).then((function(){var e=this.prop.canvas.toDataURL("image/"+this.opt.image.type,this.opt.image.quality);this.prop.img=document.createElement("img"),this.prop.img.src=e}))},A.prototype.toPdf=function(){return this.thenList([function(){return this.prop.canvas||this.toCanvas()}]).then((function(){var e=this.prop.canvas,t=this.opt,r=e.height,o=Math.floor(e.width*this.prop.pageSize.inner.ratio),s=Math.ceil(r/o),i=this.prop.pageSize.inner.height,a=document.createElement("canvas"),A=a.getContext("2d");a.width=e.width,a.height=o,this.prop.pdf=this.prop.pdf||new n.jsPDF(t.jsPDF);for(var u=0;u<s;u++){u===s-1&&r%o!=0&&(a.height=r%o,i=a.height*this.prop.pageSize.inner.width/a.width);var c=a.width,l=a.height;A.fillStyle="white",A.fillRect(0,0,c,l),A.drawImage(e,0,u*o,c,l,0,0,c,l),u&&this.prop.pdf.addPage();var d=a.toDataURL("image/"+t.image.type,t.image.quality);this.prop.pdf.addImage(d,t.image.type,t.margin[1],t.margin[0],this.prop.pageSize.inner.width,i)}}))},A.prototype.output=function(e,t,r){return"img"===(r=r||"pdf").toLowerCase()||"image"===r.toLowerCase()?this.outputImg(e,t):this.outputPdf(e,t)},A.prototype.outputPdf=function(e,t){return this.thenList([function(){return this.prop.pdf||this.toPdf()}]).then((function(){return this.prop.pdf.output(e,t)}))},A.prototype.outputImg=function(e,t){return this.thenList([function(){return this.prop.img||this.toImg()}]).then((function(){switch(e){case void 0:case"img":return this.prop.img;case"datauristring":case"dataurlstring":return this.prop.img.src;case"datauri":case"dataurl":return document.location.href=this.prop.img.src;default:throw'Image output type "'+e+'" is not supported.'}}))},A.prototype.save=function(e){return this.thenList([function(){return this.prop.pdf||this.toPdf()}]).set(e?{filename:e}:null).then((function(){this.prop.pdf.save(this.opt.filename)}))},A.prototype.set=function(e){if("object"!==(0,s.objType)(e))return this;var t=Object.keys(e||{}).map((function(t){switch(t){case"margin":return this.setMargin.bind(this,e.margin);case"jsPDF":return function(){return this.opt.jsPDF=e.jsPDF,this.setPageSize()};case"pageSize":return this.setPageSize.bind(this,e.pageSize);default:return t in A.template.prop?function(){this.prop[t]=e[t]}:function(){this.opt[t]=e[t]}}}),this);return this.then((function(){return this.thenList(t)}))},A.prototype.get=function(e,t){return this.then((function(){var r=e in A.template.prop?this.prop[e]:this.opt[e];return t?t(r):r}))},A.prototype.setMargin=function(e){return this.then((function(){switch((0,s.objType)(e)){case"number":e=[e,e,e,e];case"array":if(2===e.length&&(e=[e[0],e[1],e[0],e[1]]),4===e.length)break;default:return this.error("Invalid margin array.")}this.opt.margin=e})).then(this.setPageSize)},A.prototype.setPageSize=function(e){return this.then((function(){(e=e||n.jsPDF.getPageSize(this.opt.jsPDF)).hasOwnProperty("inner")||(e.inner={width:e.width-this.opt.margin[1]-this.opt.margin[3],height:e.height-this.opt.margin[0]-this.opt.margin[2]},e.inner.px={width:(0,s.toPx)(e.inner.width,e.k),height:(0,s.toPx)(e.inner.height,e.k)},e.inner.ratio=e.inner.height/e.inner.width),this.prop.pageSize=e}))},A.prototype.setProgress=function(e,t,r,n){return null!=e&&(this.progress.val=e),null!=t&&(this.progress.state=t),null!=r&&(this.progress.n=r),null!=n&&(this.progress.stack=n),this.progress.ratio=this.progress.val/this.progress.state,this},A.prototype.updateProgress=function(e,t,r,n){return this.setProgress(e?this.progress.val+e:null,t||null,r?this.progress.n+r:null,n?this.progress.stack.concat(n):null)},A.prototype.then=function(e,t){var r=this;return this.thenCore(e,t,(function(e,t){return r.updateProgress(null,null,1,[e]),a.prototype.then.call(this,(function(t){return r.updateProgress(null,e),t})).then(e,t).then((function(e){return r.updateProgress(1),e}))}))},A.prototype.thenCore=function(e,t,r){r=r||a.prototype.then;var n=this;e&&(e=e.bind(n)),t&&(t=t.bind(n));var o=-1!==a.toString().indexOf("[native code]")&&"Promise"===a.name?n:A.convert(Object.assign({},n),a.prototype),s=r.call(o,e,t);return A.convert(s,n.__proto__)},A.prototype.thenExternal=function(e,t){return a.prototype.then.call(this,e,t)},A.prototype.thenList=function(e){var t=this;return e.forEach((function(e){t=t.thenCore(e)})),t},A.prototype.catch=function(e){e&&(e=e.bind(this));var t=a.prototype.catch.call(this,e);return A.convert(t,this)},A.prototype.catchExternal=function(e){return a.prototype.catch.call(this,e)},A.prototype.error=function(e){return this.then((function(){throw new Error(e)}))},A.prototype.using=A.prototype.set,A.prototype.saveAs=A.prototype.save,A.prototype.export=A.prototype.output,A.prototype.run=A.prototype.then,t.default=A},"./node_modules/canvg/lib/index.es.js":function(e,t,r){"use strict";r.r(t),r.d(t,{AElement:function(){return pr},AnimateColorElement:function(){return ar},AnimateElement:function(){return ir},AnimateTransformElement:function(){return Ar},BoundingBox:function(){return Ot},CB1:function(){return at},CB2:function(){return At},CB3:function(){return ut},CB4:function(){return ct},Canvg:function(){return qr},CircleElement:function(){return Gt},ClipPathElement:function(){return Sr},DefsElement:function(){return er},DescElement:function(){return kr},Document:function(){return Kr},Element:function(){return St},EllipseElement:function(){return Xt},FeColorMatrixElement:function(){return Qr},FeCompositeElement:function(){return Ir},FeDropShadowElement:function(){return Tr},FeGaussianBlurElement:function(){return Pr},FeMorphologyElement:function(){return Hr},FilterElement:function(){return Lr},Font:function(){return Pt},FontElement:function(){return cr},FontFaceElement:function(){return lr},GElement:function(){return tr},GlyphElement:function(){return fr},GradientElement:function(){return rr},ImageElement:function(){return wr},LineElement:function(){return Wt},LinearGradientElement:function(){return nr},MarkerElement:function(){return $t},MaskElement:function(){return Fr},Matrix:function(){return Et},MissingGlyphElement:function(){return dr},Mouse:function(){return gt},PSEUDO_ZERO:function(){return nt},Parser:function(){return jt},PathElement:function(){return zt},PathParser:function(){return Kt},PatternElement:function(){return Zt},Point:function(){return mt},PolygonElement:function(){return Yt},PolylineElement:function(){return Jt},Property:function(){return ht},QB1:function(){return lt},QB2:function(){return dt},QB3:function(){return ft},RadialGradientElement:function(){return or},RectElement:function(){return qt},RenderedElement:function(){return kt},Rotate:function(){return Ct},SVGElement:function(){return Vt},SVGFontLoader:function(){return Br},Scale:function(){return xt},Screen:function(){return wt},Skew:function(){return Nt},SkewX:function(){return Qt},SkewY:function(){return Ft},StopElement:function(){return sr},StyleElement:function(){return jr},SymbolElement:function(){return br},TRefElement:function(){return hr},TSpanElement:function(){return Mt},TextElement:function(){return Rt},TextPathElement:function(){return vr},TitleElement:function(){return Or},Transform:function(){return Ut},Translate:function(){return _t},UnknownElement:function(){return Lt},UseElement:function(){return _r},ViewPort:function(){return pt},compressSpaces:function(){return Re},getSelectorSpecificity:function(){return rt},normalizeAttributeName:function(){return Ve},normalizeColor:function(){return Ge},parseExternalUrl:function(){return qe},presets:function(){return Gr},toNumbers:function(){return Ke},trimLeft:function(){return Me},trimRight:function(){return De},vectorMagnitude:function(){return ot},vectorsAngle:function(){return it},vectorsRatio:function(){return st}});var n=r("./node_modules/@babel/runtime-corejs3/core-js-stable/instance/starts-with.js"),o=r.n(n),s=r("./node_modules/@babel/runtime-corejs3/core-js-stable/parse-float.js"),i=r.n(s),a=r("./node_modules/@babel/runtime-corejs3/core-js-stable/instance/map.js"),A=r.n(a),u=r("./node_modules/@babel/runtime-corejs3/helpers/esm/slicedToArray.js"),c=r("./node_modules/@babel/runtime-corejs3/core-js-stable/object/define-property.js"),l=r.n(c),d=r("./node_modules/@babel/runtime-corejs3/core-js-stable/object/define-properties.js"),f=r.n(d),h=r("./node_modules/@babel/runtime-corejs3/core-js-stable/object/get-own-property-descriptors.js"),p=r.n(h),m=r("./node_modules/@babel/runtime-corejs3/core-js-stable/instance/for-each.js"),g=r.n(m),y=r("./node_modules/@babel/runtime-corejs3/core-js-stable/object/get-own-property-descriptor.js"),v=r.n(y),w=r("./node_modules/@babel/runtime-corejs3/core-js-stable/instance/filter.js"),b=r.n(w),B=r("./node_modules/@babel/runtime-corejs3/core-js-stable/object/get-own-property-symbols.js"),j=r.n(B),_=r("./node_modules/@babel/runtime-corejs3/core-js-stable/object/keys.js"),C=r.n(_),x=r("./node_modules/@babel/runtime-corejs3/regenerator/index.js"),E=r.n(x),N=r("./node_modules/@babel/runtime-corejs3/helpers/esm/asyncToGenerator.js"),Q=r("./node_modules/@babel/runtime-corejs3/helpers/esm/defineProperty.js"),F=r("./node_modules/@babel/runtime-corejs3/helpers/esm/classCallCheck.js"),U=r("./node_modules/@babel/runtime-corejs3/helpers/esm/createClass.js"),S=r("./node_modules/@babel/runtime-corejs3/core-js-stable/instance/concat.js"),L=r.n(S),T=r("./node_modules/@babel/runtime-corejs3/core-js-stable/instance/reduce.js"),H=r.n(T),I=r("./node_modules/@babel/runtime-corejs3/core-js-stable/date/now.js"),P=r.n(I),O=r("./node_modules/@babel/runtime-corejs3/core-js-stable/instance/every.js"),k=r.n(O),R=r("./node_modules/@babel/runtime-corejs3/core-js-stable/promise.js"),M=r.n(R),D=r("./node_modules/@babel/runtime-corejs3/core-js-stable/instance/bind.js"),K=r.n(D),z=r("./node_modules/raf/index.js"),V=r.n(z),q=r("./node_modules/@babel/runtime-corejs3/core-js-stable/instance/trim.js"),G=r.n(q),X=r("./node_modules/rgbcolor/index.js"),W=r.n(X),J=r("./node_modules/@babel/runtime-corejs3/core-js-stable/reflect/construct.js"),Y=r.n(J),Z=r("./node_modules/@babel/runtime-corejs3/helpers/esm/inherits.js"),$=r("./node_modules/@babel/runtime-corejs3/helpers/esm/possibleConstructorReturn.js"),ee=r("./node_modules/@babel/runtime-corejs3/helpers/esm/getPrototypeOf.js"),te=r("./node_modules/@babel/runtime-corejs3/helpers/esm/toConsumableArray.js"),re=r("./node_modules/@babel/runtime-corejs3/core-js-stable/instance/some.js"),ne=r.n(re),oe=r("./node_modules/@babel/runtime-corejs3/core-js-stable/instance/includes.js"),se=r.n(oe),ie=r("./node_modules/@babel/runtime-corejs3/core-js-stable/array/from.js"),ae=r.n(ie),Ae=r("./node_modules/@babel/runtime-corejs3/core-js-stable/instance/reverse.js"),ue=r.n(Ae),ce=r("./node_modules/@babel/runtime-corejs3/core-js-stable/instance/index-of.js"),le=r.n(ce),de=r("./node_modules/@babel/runtime-corejs3/helpers/esm/get.js"),fe=r("./node_modules/@babel/runtime-corejs3/core-js-stable/instance/fill.js"),he=r.n(fe),pe=r("./node_modules/svg-pathdata/lib/SVGPathData.module.js"),me=r("./node_modules/@babel/runtime-corejs3/core-js-stable/reflect/delete-property.js"),ge=r.n(me),ye=r("./node_modules/@babel/runtime-corejs3/helpers/esm/assertThisInitialized.js"),ve=r("./node_modules/@babel/runtime-corejs3/core-js-stable/instance/values.js"),we=r.n(ve),be=r("./node_modules/@babel/runtime-corejs3/core-js-stable/parse-int.js"),Be=r.n(be),je=r("./node_modules/@babel/runtime-corejs3/core-js/get-iterator.js"),_e=r.n(je),Ce=r("./node_modules/@babel/runtime-corejs3/core-js-stable/array/is-array.js"),xe=r.n(Ce),Ee=r("./node_modules/@babel/runtime-corejs3/core-js/get-iterator-method.js"),Ne=r.n(Ee),Qe=r("./node_modules/@babel/runtime-corejs3/core-js-stable/symbol.js"),Fe=r.n(Qe),Ue=r("./node_modules/@babel/runtime-corejs3/core-js-stable/instance/slice.js"),Se=r.n(Ue),Le=r("./node_modules/@babel/runtime-corejs3/core-js-stable/map.js"),Te=r.n(Le),He=r("./node_modules/@babel/runtime-corejs3/core-js-stable/reflect/apply.js"),Ie=r.n(He),Pe=r("./node_modules/@babel/runtime-corejs3/core-js-stable/reflect/get-prototype-of.js"),Oe=r.n(Pe),ke=r("./node_modules/stackblur-canvas/dist/stackblur-es.js");function Re(e){return e.replace(/(?!\u3000)\s+/gm," ")}function Me(e){return e.replace(/^[\n \t]+/,"")}function De(e){return e.replace(/[\n \t]+$/,"")}function Ke(e){var t=(e||"").match(/-?(\d+(?:\.\d*(?:[eE][+-]?\d+)?)?|\.\d+)(?=\D|$)/gm)||[];return A()(t).call(t,i())}var ze=/^[A-Z-]+$/;function Ve(e){return ze.test(e)?e.toLowerCase():e}function qe(e){var t=e.match(/url\(('([^']+)'|"([^"]+)"|([^'"\)]+))\)/)||[];return t[2]||t[3]||t[4]}function Ge(e){if(!o()(e).call(e,"rgb"))return e;var t=3;return e.replace(/\d+(\.\d+)?/g,(function(e,r){return t--&&r?String(Math.round(i()(e))):e}))}var Xe=/(\[[^\]]+\])/g,We=/(#[^\s\+>~\.\[:]+)/g,Je=/(\.[^\s\+>~\.\[:]+)/g,Ye=/(::[^\s\+>~\.\[:]+|:first-line|:first-letter|:before|:after)/gi,Ze=/(:[\w-]+\([^\)]*\))/gi,$e=/(:[^\s\+>~\.\[:]+)/g,et=/([^\s\+>~\.\[:]+)/g;function tt(e,t){var r=e.match(t);return r?[e.replace(t," "),r.length]:[e,0]}function rt(e){var t=[0,0,0],r=e.replace(/:not\(([^\)]*)\)/g,"     $1 ").replace(/{[\s\S]*/gm," "),n=0,o=tt(r,Xe),s=(0,u.default)(o,2);r=s[0],n=s[1],t[1]+=n;var i=tt(r,We),a=(0,u.default)(i,2);r=a[0],n=a[1],t[0]+=n;var A=tt(r,Je),c=(0,u.default)(A,2);r=c[0],n=c[1],t[1]+=n;var l=tt(r,Ye),d=(0,u.default)(l,2);r=d[0],n=d[1],t[2]+=n;var f=tt(r,Ze),h=(0,u.default)(f,2);r=h[0],n=h[1],t[1]+=n;var p=tt(r,$e),m=(0,u.default)(p,2);r=m[0],n=m[1],t[1]+=n;var g=tt(r=r.replace(/[\*\s\+>~]/g," ").replace(/[#\.]/g," "),et),y=(0,u.default)(g,2);return r=y[0],n=y[1],t[2]+=n,t.join("")}var nt=1e-8;function ot(e){return Math.sqrt(Math.pow(e[0],2)+Math.pow(e[1],2))}function st(e,t){return(e[0]*t[0]+e[1]*t[1])/(ot(e)*ot(t))}function it(e,t){return(e[0]*t[1]<e[1]*t[0]?-1:1)*Math.acos(st(e,t))}function at(e){return e*e*e}function At(e){return 3*e*e*(1-e)}function ut(e){return 3*e*(1-e)*(1-e)}function ct(e){return(1-e)*(1-e)*(1-e)}function lt(e){return e*e}function dt(e){return 2*e*(1-e)}function ft(e){return(1-e)*(1-e)}var ht=function(){function e(t,r,n){(0,F.default)(this,e),this.document=t,this.name=r,this.value=n,this.isNormalizedColor=!1}return(0,U.default)(e,[{key:"split",value:function(){var t,r,n=arguments.length>0&&void 0!==arguments[0]?arguments[0]:" ",o=this.document,s=this.name;return A()(t=G()(r=Re(this.getString())).call(r).split(n)).call(t,(function(t){return new e(o,s,t)}))}},{key:"hasValue",value:function(e){var t=this.value;return null!==t&&""!==t&&(e||0!==t)&&void 0!==t}},{key:"isString",value:function(e){var t=this.value,r="string"==typeof t;return r&&e?e.test(t):r}},{key:"isUrlDefinition",value:function(){return this.isString(/^url\(/)}},{key:"isPixels",value:function(){if(!this.hasValue())return!1;var e=this.getString();switch(!0){case/px$/.test(e):case/^[0-9]+$/.test(e):return!0;default:return!1}}},{key:"setValue",value:function(e){return this.value=e,this}},{key:"getValue",value:function(e){return void 0===e||this.hasValue()?this.value:e}},{key:"getNumber",value:function(e){if(!this.hasValue())return void 0===e?0:i()(e);var t=this.value,r=i()(t);return this.isString(/%$/)&&(r/=100),r}},{key:"getString",value:function(e){return void 0===e||this.hasValue()?void 0===this.value?"":String(this.value):String(e)}},{key:"getColor",value:function(e){var t=this.getString(e);return this.isNormalizedColor||(this.isNormalizedColor=!0,t=Ge(t),this.value=t),t}},{key:"getDpi",value:function(){return 96}},{key:"getRem",value:function(){return this.document.rootEmSize}},{key:"getEm",value:function(){return this.document.emSize}},{key:"getUnits",value:function(){return this.getString().replace(/[0-9\.\-]/g,"")}},{key:"getPixels",value:function(e){var t=arguments.length>1&&void 0!==arguments[1]&&arguments[1];if(!this.hasValue())return 0;var r="boolean"==typeof e?[void 0,e]:[e],n=(0,u.default)(r,2),o=n[0],s=n[1],i=this.document.screen.viewPort;switch(!0){case this.isString(/vmin$/):return this.getNumber()/100*Math.min(i.computeSize("x"),i.computeSize("y"));case this.isString(/vmax$/):return this.getNumber()/100*Math.max(i.computeSize("x"),i.computeSize("y"));case this.isString(/vw$/):return this.getNumber()/100*i.computeSize("x");case this.isString(/vh$/):return this.getNumber()/100*i.computeSize("y");case this.isString(/rem$/):return this.getNumber()*this.getRem();case this.isString(/em$/):return this.getNumber()*this.getEm();case this.isString(/ex$/):return this.getNumber()*this.getEm()/2;case this.isString(/px$/):return this.getNumber();case this.isString(/pt$/):return this.getNumber()*this.getDpi()*(1/72);case this.isString(/pc$/):return 15*this.getNumber();case this.isString(/cm$/):return this.getNumber()*this.getDpi()/2.54;case this.isString(/mm$/):return this.getNumber()*this.getDpi()/25.4;case this.isString(/in$/):return this.getNumber()*this.getDpi();case this.isString(/%$/)&&s:return this.getNumber()*this.getEm();case this.isString(/%$/):return this.getNumber()*i.computeSize(o);default:var a=this.getNumber();return t&&a<1?a*i.computeSize(o):a}}},{key:"getMilliseconds",value:function(){return this.hasValue()?this.isString(/ms$/)?this.getNumber():1e3*this.getNumber():0}},{key:"getRadians",value:function(){if(!this.hasValue())return 0;switch(!0){case this.isString(/deg$/):return this.getNumber()*(Math.PI/180);case this.isString(/grad$/):return this.getNumber()*(Math.PI/200);case this.isString(/rad$/):return this.getNumber();default:return this.getNumber()*(Math.PI/180)}}},{key:"getDefinition",value:function(){var e=this.getString(),t=e.match(/#([^\)'"]+)/);return t&&(t=t[1]),t||(t=e),this.document.definitions[t]}},{key:"getFillStyleDefinition",value:function(e,t){var r=this.getDefinition();if(!r)return null;if("function"==typeof r.createGradient)return r.createGradient(this.document.ctx,e,t);if("function"==typeof r.createPattern){if(r.getHrefAttribute().hasValue()){var n=r.getAttribute("patternTransform");r=r.getHrefAttribute().getDefinition(),n.hasValue()&&r.getAttribute("patternTransform",!0).setValue(n.value)}return r.createPattern(this.document.ctx,e,t)}return null}},{key:"getTextBaseline",value:function(){return this.hasValue()?e.textBaselineMapping[this.getString()]:null}},{key:"addOpacity",value:function(t){for(var r=this.getColor(),n=r.length,o=0,s=0;s<n&&(","===r[s]&&o++,3!==o);s++);if(t.hasValue()&&this.isString()&&3!==o){var i=new(W())(r);i.ok&&(i.alpha=t.getNumber(),r=i.toRGBA())}return new e(this.document,this.name,r)}}],[{key:"empty",value:function(t){return new e(t,"EMPTY","")}}]),e}();ht.textBaselineMapping={baseline:"alphabetic","before-edge":"top","text-before-edge":"top",middle:"middle",central:"middle","after-edge":"bottom","text-after-edge":"bottom",ideographic:"ideographic",alphabetic:"alphabetic",hanging:"hanging",mathematical:"alphabetic"};var pt=function(){function e(){(0,F.default)(this,e),this.viewPorts=[]}return(0,U.default)(e,[{key:"clear",value:function(){this.viewPorts=[]}},{key:"setCurrent",value:function(e,t){this.viewPorts.push({width:e,height:t})}},{key:"removeCurrent",value:function(){this.viewPorts.pop()}},{key:"getCurrent",value:function(){var e=this.viewPorts;return e[e.length-1]}},{key:"computeSize",value:function(e){return"number"==typeof e?e:"x"===e?this.width:"y"===e?this.height:Math.sqrt(Math.pow(this.width,2)+Math.pow(this.height,2))/Math.sqrt(2)}},{key:"width",get:function(){return this.getCurrent().width}},{key:"height",get:function(){return this.getCurrent().height}}]),e}(),mt=function(){function e(t,r){(0,F.default)(this,e),this.x=t,this.y=r}return(0,U.default)(e,[{key:"angleTo",value:function(e){return Math.atan2(e.y-this.y,e.x-this.x)}},{key:"applyTransform",value:function(e){var t=this.x,r=this.y,n=t*e[0]+r*e[2]+e[4],o=t*e[1]+r*e[3]+e[5];this.x=n,this.y=o}}],[{key:"parse",value:function(t){var r=arguments.length>1&&void 0!==arguments[1]?arguments[1]:0,n=Ke(t),o=(0,u.default)(n,2),s=o[0],i=void 0===s?r:s,a=o[1],A=void 0===a?r:a;return new e(i,A)}},{key:"parseScale",value:function(t){var r=arguments.length>1&&void 0!==arguments[1]?arguments[1]:1,n=Ke(t),o=(0,u.default)(n,2),s=o[0],i=void 0===s?r:s,a=o[1],A=void 0===a?i:a;return new e(i,A)}},{key:"parsePath",value:function(t){for(var r=Ke(t),n=r.length,o=[],s=0;s<n;s+=2)o.push(new e(r[s],r[s+1]));return o}}]),e}(),gt=function(){function e(t){var r,n;(0,F.default)(this,e),this.screen=t,this.working=!1,this.events=[],this.eventElements=[],this.onClick=K()(r=this.onClick).call(r,this),this.onMouseMove=K()(n=this.onMouseMove).call(n,this)}return(0,U.default)(e,[{key:"isWorking",value:function(){return this.working}},{key:"start",value:function(){if(!this.working){var e=this.screen,t=this.onClick,r=this.onMouseMove,n=e.ctx.canvas;n.onclick=t,n.onmousemove=r,this.working=!0}}},{key:"stop",value:function(){if(this.working){var e=this.screen.ctx.canvas;this.working=!1,e.onclick=null,e.onmousemove=null}}},{key:"hasEvents",value:function(){return this.working&&this.events.length>0}},{key:"runEvents",value:function(){if(this.working){var e=this.screen,t=this.events,r=this.eventElements,n=e.ctx.canvas.style;n&&(n.cursor=""),g()(t).call(t,(function(e,t){for(var n=e.run,o=r[t];o;)n(o),o=o.parent})),this.events=[],this.eventElements=[]}}},{key:"checkPath",value:function(e,t){if(this.working&&t){var r=this.events,n=this.eventElements;g()(r).call(r,(function(r,o){var s=r.x,i=r.y;!n[o]&&t.isPointInPath&&t.isPointInPath(s,i)&&(n[o]=e)}))}}},{key:"checkBoundingBox",value:function(e,t){if(this.working&&t){var r=this.events,n=this.eventElements;g()(r).call(r,(function(r,o){var s=r.x,i=r.y;!n[o]&&t.isPointInBox(s,i)&&(n[o]=e)}))}}},{key:"mapXY",value:function(e,t){for(var r=this.screen,n=r.window,o=r.ctx,s=new mt(e,t),i=o.canvas;i;)s.x-=i.offsetLeft,s.y-=i.offsetTop,i=i.offsetParent;return n.scrollX&&(s.x+=n.scrollX),n.scrollY&&(s.y+=n.scrollY),s}},{key:"onClick",value:function(e){var t=this.mapXY((e||event).clientX,(e||event).clientY),r=t.x,n=t.y;this.events.push({type:"onclick",x:r,y:n,run:function(e){e.onClick&&e.onClick()}})}},{key:"onMouseMove",value:function(e){var t=this.mapXY((e||event).clientX,(e||event).clientY),r=t.x,n=t.y;this.events.push({type:"onmousemove",x:r,y:n,run:function(e){e.onMouseMove&&e.onMouseMove()}})}}]),e}(),yt="undefined"!=typeof window?window:null,vt="undefined"!=typeof fetch?K()(fetch).call(fetch,void 0):null,wt=function(){function e(t){var r=arguments.length>1&&void 0!==arguments[1]?arguments[1]:{},n=r.fetch,o=void 0===n?vt:n,s=r.window,i=void 0===s?yt:s;(0,F.default)(this,e),this.ctx=t,this.FRAMERATE=30,this.MAX_VIRTUAL_PIXELS=3e4,this.CLIENT_WIDTH=800,this.CLIENT_HEIGHT=600,this.viewPort=new pt,this.mouse=new gt(this),this.animations=[],this.waits=[],this.frameDuration=0,this.isReadyLock=!1,this.isFirstRender=!0,this.intervalId=null,this.window=i,this.fetch=o}return(0,U.default)(e,[{key:"wait",value:function(e){this.waits.push(e)}},{key:"ready",value:function(){return this.readyPromise?this.readyPromise:M().resolve()}},{key:"isReady",value:function(){var e;if(this.isReadyLock)return!0;var t=k()(e=this.waits).call(e,(function(e){return e()}));return t&&(this.waits=[],this.resolveReady&&this.resolveReady()),this.isReadyLock=t,t}},{key:"setDefaults",value:function(e){e.strokeStyle="rgba(0,0,0,0)",e.lineCap="butt",e.lineJoin="miter",e.miterLimit=4}},{key:"setViewBox",value:function(e){var t=e.document,r=e.ctx,n=e.aspectRatio,o=e.width,s=e.desiredWidth,i=e.height,a=e.desiredHeight,A=e.minX,c=void 0===A?0:A,l=e.minY,d=void 0===l?0:l,f=e.refX,h=e.refY,p=e.clip,m=void 0!==p&&p,g=e.clipX,y=void 0===g?0:g,v=e.clipY,w=void 0===v?0:v,b=Re(n).replace(/^defer\s/,"").split(" "),B=(0,u.default)(b,2),j=B[0]||"xMidYMid",_=B[1]||"meet",C=o/s,x=i/a,E=Math.min(C,x),N=Math.max(C,x),Q=s,F=a;"meet"===_&&(Q*=E,F*=E),"slice"===_&&(Q*=N,F*=N);var U=new ht(t,"refX",f),S=new ht(t,"refY",h),L=U.hasValue()&&S.hasValue();if(L&&r.translate(-E*U.getPixels("x"),-E*S.getPixels("y")),m){var T=E*y,H=E*w;r.beginPath(),r.moveTo(T,H),r.lineTo(o,H),r.lineTo(o,i),r.lineTo(T,i),r.closePath(),r.clip()}if(!L){var I="meet"===_&&E===x,P="slice"===_&&N===x,O="meet"===_&&E===C,k="slice"===_&&N===C;/^xMid/.test(j)&&(I||P)&&r.translate(o/2-Q/2,0),/YMid$/.test(j)&&(O||k)&&r.translate(0,i/2-F/2),/^xMax/.test(j)&&(I||P)&&r.translate(o-Q,0),/YMax$/.test(j)&&(O||k)&&r.translate(0,i-F)}switch(!0){case"none"===j:r.scale(C,x);break;case"meet"===_:r.scale(E,E);break;case"slice"===_:r.scale(N,N)}r.translate(-c,-d)}},{key:"start",value:function(e){var t=this,r=arguments.length>1&&void 0!==arguments[1]?arguments[1]:{},n=r.enableRedraw,o=void 0!==n&&n,s=r.ignoreMouse,i=void 0!==s&&s,a=r.ignoreAnimation,A=void 0!==a&&a,u=r.ignoreDimensions,c=void 0!==u&&u,l=r.ignoreClear,d=void 0!==l&&l,f=r.forceRedraw,h=r.scaleWidth,p=r.scaleHeight,m=r.offsetX,g=r.offsetY,y=this.FRAMERATE,v=this.mouse,w=1e3/y;if(this.frameDuration=w,this.readyPromise=new(M())((function(e){t.resolveReady=e})),this.isReady()&&this.render(e,c,d,h,p,m,g),o){var b=P()(),B=b,j=0,_=function r(){b=P()(),(j=b-B)>=w&&(B=b-j%w,t.shouldUpdate(A,f)&&(t.render(e,c,d,h,p,m,g),v.runEvents())),t.intervalId=V()(r)};i||v.start(),this.intervalId=V()(_)}}},{key:"stop",value:function(){this.intervalId&&(V().cancel(this.intervalId),this.intervalId=null),this.mouse.stop()}},{key:"shouldUpdate",value:function(e,t){if(!e){var r,n=this.frameDuration;if(H()(r=this.animations).call(r,(function(e,t){return t.update(n)||e}),!1))return!0}return!("function"!=typeof t||!t())||!(this.isReadyLock||!this.isReady())||!!this.mouse.hasEvents()}},{key:"render",value:function(e,t,r,n,o,s,i){var a=this.CLIENT_WIDTH,A=this.CLIENT_HEIGHT,u=this.viewPort,c=this.ctx,l=this.isFirstRender,d=c.canvas;u.clear(),d.width&&d.height?u.setCurrent(d.width,d.height):u.setCurrent(a,A);var f=e.getStyle("width"),h=e.getStyle("height");!t&&(l||"number"!=typeof n&&"number"!=typeof o)&&(f.hasValue()&&(d.width=f.getPixels("x"),d.style&&(d.style.width="".concat(d.width,"px"))),h.hasValue()&&(d.height=h.getPixels("y"),d.style&&(d.style.height="".concat(d.height,"px"))));var p=d.clientWidth||d.width,m=d.clientHeight||d.height;if(t&&f.hasValue()&&h.hasValue()&&(p=f.getPixels("x"),m=h.getPixels("y")),u.setCurrent(p,m),"number"==typeof s&&e.getAttribute("x",!0).setValue(s),"number"==typeof i&&e.getAttribute("y",!0).setValue(i),"number"==typeof n||"number"==typeof o){var g,y,v=Ke(e.getAttribute("viewBox").getString()),w=0,b=0;if("number"==typeof n){var B=e.getStyle("width");B.hasValue()?w=B.getPixels("x")/n:isNaN(v[2])||(w=v[2]/n)}if("number"==typeof o){var j=e.getStyle("height");j.hasValue()?b=j.getPixels("y")/o:isNaN(v[3])||(b=v[3]/o)}w||(w=b),b||(b=w),e.getAttribute("width",!0).setValue(n),e.getAttribute("height",!0).setValue(o);var _=e.getStyle("transform",!0,!0);_.setValue(L()(g=L()(y="".concat(_.getString()," scale(")).call(y,1/w,", ")).call(g,1/b,")"))}r||c.clearRect(0,0,p,m),e.render(c),l&&(this.isFirstRender=!1)}}]),e}();wt.defaultWindow=yt,wt.defaultFetch=vt;var bt=wt.defaultFetch,Bt="undefined"!=typeof DOMParser?DOMParser:null,jt=function(){function e(){var t=arguments.length>0&&void 0!==arguments[0]?arguments[0]:{},r=t.fetch,n=void 0===r?bt:r,o=t.DOMParser,s=void 0===o?Bt:o;(0,F.default)(this,e),this.fetch=n,this.DOMParser=s}var t,r;return(0,U.default)(e,[{key:"parse",value:(r=(0,N.default)(E().mark((function e(t){return E().wrap((function(e){for(;;)switch(e.prev=e.next){case 0:if(!/^</.test(t)){e.next=2;break}return e.abrupt("return",this.parseFromString(t));case 2:return e.abrupt("return",this.load(t));case 3:case"end":return e.stop()}}),e,this)}))),function(e){return r.apply(this,arguments)})},{key:"parseFromString",value:function(e){var t=new this.DOMParser;try{return this.checkDocument(t.parseFromString(e,"image/svg+xml"))}catch(r){return this.checkDocument(t.parseFromString(e,"text/xml"))}}},{key:"checkDocument",value:function(e){var t=e.getElementsByTagName("parsererror")[0];if(t)throw new Error(t.textContent);return e}},{key:"load",value:(t=(0,N.default)(E().mark((function e(t){var r,n;return E().wrap((function(e){for(;;)switch(e.prev=e.next){case 0:return e.next=2,this.fetch(t);case 2:return r=e.sent,e.next=5,r.text();case 5:return n=e.sent,e.abrupt("return",this.parseFromString(n));case 7:case"end":return e.stop()}}),e,this)}))),function(e){return t.apply(this,arguments)})}]),e}(),_t=function(){function e(t,r){(0,F.default)(this,e),this.type="translate",this.point=null,this.point=mt.parse(r)}return(0,U.default)(e,[{key:"apply",value:function(e){var t=this.point,r=t.x,n=t.y;e.translate(r||0,n||0)}},{key:"unapply",value:function(e){var t=this.point,r=t.x,n=t.y;e.translate(-1*r||0,-1*n||0)}},{key:"applyToPoint",value:function(e){var t=this.point,r=t.x,n=t.y;e.applyTransform([1,0,0,1,r||0,n||0])}}]),e}(),Ct=function(){function e(t,r,n){(0,F.default)(this,e),this.type="rotate",this.angle=null,this.originX=null,this.originY=null,this.cx=0,this.cy=0;var o=Ke(r);this.angle=new ht(t,"angle",o[0]),this.originX=n[0],this.originY=n[1],this.cx=o[1]||0,this.cy=o[2]||0}return(0,U.default)(e,[{key:"apply",value:function(e){var t=this.cx,r=this.cy,n=this.originX,o=this.originY,s=this.angle,i=t+n.getPixels("x"),a=r+o.getPixels("y");e.translate(i,a),e.rotate(s.getRadians()),e.translate(-i,-a)}},{key:"unapply",value:function(e){var t=this.cx,r=this.cy,n=this.angle;e.translate(t,r),e.rotate(-1*n.getRadians()),e.translate(-t,-r)}},{key:"applyToPoint",value:function(e){var t=this.cx,r=this.cy,n=this.angle.getRadians();e.applyTransform([1,0,0,1,t||0,r||0]),e.applyTransform([Math.cos(n),Math.sin(n),-Math.sin(n),Math.cos(n),0,0]),e.applyTransform([1,0,0,1,-t||0,-r||0])}}]),e}(),xt=function(){function e(t,r){(0,F.default)(this,e),this.type="scale",this.scale=null;var n=mt.parseScale(r);0!==n.x&&0!==n.y||(n.x=nt,n.y=nt),this.scale=n}return(0,U.default)(e,[{key:"apply",value:function(e){var t=this.scale,r=t.x,n=t.y;e.scale(r,n||r)}},{key:"unapply",value:function(e){var t=this.scale,r=t.x,n=t.y;e.scale(1/r,1/n||r)}},{key:"applyToPoint",value:function(e){var t=this.scale,r=t.x,n=t.y;e.applyTransform([r||0,0,0,n||0,0,0])}}]),e}(),Et=function(){function e(t,r){(0,F.default)(this,e),this.type="matrix",this.matrix=[],this.matrix=Ke(r)}return(0,U.default)(e,[{key:"apply",value:function(e){var t=this.matrix;e.transform(t[0],t[1],t[2],t[3],t[4],t[5])}},{key:"unapply",value:function(e){var t=this.matrix,r=t[0],n=t[2],o=t[4],s=t[1],i=t[3],a=t[5],A=1/(r*(1*i-0*a)-n*(1*s-0*a)+o*(0*s-0*i));e.transform(A*(1*i-0*a),A*(0*a-1*s),A*(0*o-1*n),A*(1*r-0*o),A*(n*a-o*i),A*(o*s-r*a))}},{key:"applyToPoint",value:function(e){e.applyTransform(this.matrix)}}]),e}();var Nt=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t){var r;return(0,F.default)(this,o),(r=n.call(this,e,t)).type="skew",r.angle=null,r.angle=new ht(e,"angle",t),r}return o}(Et);var Qt=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t){var r;return(0,F.default)(this,o),(r=n.call(this,e,t)).type="skewX",r.matrix=[1,0,Math.tan(r.angle.getRadians()),1,0,0],r}return o}(Nt);var Ft=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t){var r;return(0,F.default)(this,o),(r=n.call(this,e,t)).type="skewY",r.matrix=[1,Math.tan(r.angle.getRadians()),0,1,0,0],r}return o}(Nt),Ut=function(){function e(t,r,n){var o=this;(0,F.default)(this,e),this.document=t,this.transforms=[];var s=function(e){var t;return G()(t=Re(e)).call(t).replace(/\)([a-zA-Z])/g,") $1").replace(/\)(\s?,\s?)/g,") ").split(/\s(?=[a-z])/)}(r);g()(s).call(s,(function(t){if("none"!==t){var r=function(e){var t=e.split("("),r=(0,u.default)(t,2),n=r[0],o=r[1];return[G()(n).call(n),G()(o).call(o).replace(")","")]}(t),s=(0,u.default)(r,2),i=s[0],a=s[1],A=e.transformTypes[i];void 0!==A&&o.transforms.push(new A(o.document,a,n))}}))}return(0,U.default)(e,[{key:"apply",value:function(e){for(var t=this.transforms,r=t.length,n=0;n<r;n++)t[n].apply(e)}},{key:"unapply",value:function(e){for(var t=this.transforms,r=t.length-1;r>=0;r--)t[r].unapply(e)}},{key:"applyToPoint",value:function(e){for(var t=this.transforms,r=t.length,n=0;n<r;n++)t[n].applyToPoint(e)}}],[{key:"fromElement",value:function(t,r){var n=r.getStyle("transform",!1,!0),o=r.getStyle("transform-origin",!1,!0).split(),s=(0,u.default)(o,2),i=s[0],a=s[1],A=[i,void 0===a?i:a];return n.hasValue()?new e(t,n.getString(),A):null}}]),e}();Ut.transformTypes={translate:_t,rotate:Ct,scale:xt,matrix:Et,skewX:Qt,skewY:Ft};var St=function(){function e(t,r){var n,o,s=this,i=arguments.length>2&&void 0!==arguments[2]&&arguments[2];if((0,F.default)(this,e),this.document=t,this.node=r,this.captureTextNodes=i,this.attributes={},this.styles={},this.stylesSpecificity={},this.animationFrozen=!1,this.animationFrozenValue="",this.parent=null,this.children=[],r&&1===r.nodeType){if(g()(n=ae()(r.attributes)).call(n,(function(e){var r=Ve(e.nodeName);s.attributes[r]=new ht(t,r,e.value)})),this.addStylesFromStyleDefinition(),this.getAttribute("style").hasValue()){var a,c=A()(a=this.getAttribute("style").getString().split(";")).call(a,(function(e){return G()(e).call(e)}));g()(c).call(c,(function(e){var r;if(e){var n=A()(r=e.split(":")).call(r,(function(e){return G()(e).call(e)})),o=(0,u.default)(n,2),i=o[0],a=o[1];s.styles[i]=new ht(t,i,a)}}))}var l=t.definitions,d=this.getAttribute("id");d.hasValue()&&(l[d.getValue()]||(l[d.getValue()]=this)),g()(o=ae()(r.childNodes)).call(o,(function(e){if(1===e.nodeType)s.addChild(e);else if(i&&(3===e.nodeType||4===e.nodeType)){var r=t.createTextNode(e);r.getText().length>0&&s.addChild(r)}}))}}return(0,U.default)(e,[{key:"getAttribute",value:function(e){var t=arguments.length>1&&void 0!==arguments[1]&&arguments[1],r=this.attributes[e];if(!r&&t){var n=new ht(this.document,e,"");return this.attributes[e]=n,n}return r||ht.empty(this.document)}},{key:"getHrefAttribute",value:function(){for(var e in this.attributes)if("href"===e||/:href$/.test(e))return this.attributes[e];return ht.empty(this.document)}},{key:"getStyle",value:function(e){var t=arguments.length>1&&void 0!==arguments[1]&&arguments[1],r=arguments.length>2&&void 0!==arguments[2]&&arguments[2],n=this.styles[e];if(n)return n;var o=this.getAttribute(e);if(o&&o.hasValue())return this.styles[e]=o,o;if(!r){var s=this.parent;if(s){var i=s.getStyle(e);if(i&&i.hasValue())return i}}if(t){var a=new ht(this.document,e,"");return this.styles[e]=a,a}return n||ht.empty(this.document)}},{key:"render",value:function(e){if("none"!==this.getStyle("display").getString()&&"hidden"!==this.getStyle("visibility").getString()){if(e.save(),this.getStyle("mask").hasValue()){var t=this.getStyle("mask").getDefinition();t&&(this.applyEffects(e),t.apply(e,this))}else if("none"!==this.getStyle("filter").getValue("none")){var r=this.getStyle("filter").getDefinition();r&&(this.applyEffects(e),r.apply(e,this))}else this.setContext(e),this.renderChildren(e),this.clearContext(e);e.restore()}}},{key:"setContext",value:function(e){}},{key:"applyEffects",value:function(e){var t=Ut.fromElement(this.document,this);t&&t.apply(e);var r=this.getStyle("clip-path",!1,!0);if(r.hasValue()){var n=r.getDefinition();n&&n.apply(e)}}},{key:"clearContext",value:function(e){}},{key:"renderChildren",value:function(e){var t;g()(t=this.children).call(t,(function(t){t.render(e)}))}},{key:"addChild",value:function(t){var r,n=t instanceof e?t:this.document.createElement(t);n.parent=this,se()(r=e.ignoreChildTypes).call(r,n.type)||this.children.push(n)}},{key:"matchesSelector",value:function(e){var t,r=this.node;if("function"==typeof r.matches)return r.matches(e);var n=r.getAttribute("class");return!(!n||""===n)&&ne()(t=n.split(" ")).call(t,(function(t){if(".".concat(t)===e)return!0}))}},{key:"addStylesFromStyleDefinition",value:function(){var e=this.document,t=e.styles,r=e.stylesSpecificity;for(var n in t)if("@"!==n[0]&&this.matchesSelector(n)){var o=t[n],s=r[n];if(o)for(var i in o){var a=this.stylesSpecificity[i];void 0===a&&(a="000"),s>=a&&(this.styles[i]=o[i],this.stylesSpecificity[i]=s)}}}},{key:"removeStyles",value:function(e,t){return H()(t).call(t,(function(t,r){var n,o=e.getStyle(r);if(!o.hasValue())return t;var s=o.getString();return o.setValue(""),L()(n=[]).call(n,(0,te.default)(t),[[r,s]])}),[])}},{key:"restoreStyles",value:function(e,t){g()(t).call(t,(function(t){var r=(0,u.default)(t,2),n=r[0],o=r[1];e.getStyle(n,!0).setValue(o)}))}}]),e}();St.ignoreChildTypes=["title"];var Lt=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){return(0,F.default)(this,o),n.call(this,e,t,r)}return o}(St);function Tt(e){var t=G()(e).call(e);return/^('|")/.test(t)?t:'"'.concat(t,'"')}function Ht(e){if(!e)return"";var t=G()(e).call(e).toLowerCase();switch(t){case"normal":case"italic":case"oblique":case"inherit":case"initial":case"unset":return t;default:return/^oblique\s+(-|)\d+deg$/.test(t)?t:""}}function It(e){if(!e)return"";var t=G()(e).call(e).toLowerCase();switch(t){case"normal":case"bold":case"lighter":case"bolder":case"inherit":case"initial":case"unset":return t;default:return/^[\d.]+$/.test(t)?t:""}}var Pt=function(){function e(t,r,n,o,s,i){(0,F.default)(this,e);var a=i?"string"==typeof i?e.parse(i):i:{};this.fontFamily=s||a.fontFamily,this.fontSize=o||a.fontSize,this.fontStyle=t||a.fontStyle,this.fontWeight=n||a.fontWeight,this.fontVariant=r||a.fontVariant}return(0,U.default)(e,[{key:"toString",value:function(){var e,t,r;return G()(e=[Ht(this.fontStyle),this.fontVariant,It(this.fontWeight),this.fontSize,(t=this.fontFamily,"undefined"==typeof process?t:A()(r=G()(t).call(t).split(",")).call(r,Tt).join(","))].join(" ")).call(e)}}],[{key:"parse",value:function(){var t,r=arguments.length>0&&void 0!==arguments[0]?arguments[0]:"",n=arguments.length>1?arguments[1]:void 0,o="",s="",i="",a="",A="",c=G()(t=Re(r)).call(t).split(" "),l={fontSize:!1,fontStyle:!1,fontWeight:!1,fontVariant:!1};return g()(c).call(c,(function(t){var r,n,c;switch(!0){case!l.fontStyle&&se()(r=e.styles).call(r,t):"inherit"!==t&&(o=t),l.fontStyle=!0;break;case!l.fontVariant&&se()(n=e.variants).call(n,t):"inherit"!==t&&(s=t),l.fontStyle=!0,l.fontVariant=!0;break;case!l.fontWeight&&se()(c=e.weights).call(c,t):"inherit"!==t&&(i=t),l.fontStyle=!0,l.fontVariant=!0,l.fontWeight=!0;break;case!l.fontSize:if("inherit"!==t){var d=t.split("/"),f=(0,u.default)(d,1);a=f[0]}l.fontStyle=!0,l.fontVariant=!0,l.fontWeight=!0,l.fontSize=!0;break;default:"inherit"!==t&&(A+=t)}})),new e(o,s,i,a,A,n)}}]),e}();Pt.styles="normal|italic|oblique|inherit",Pt.variants="normal|small-caps|inherit",Pt.weights="normal|bold|bolder|lighter|100|200|300|400|500|600|700|800|900|inherit";var Ot=function(){function e(){var t=arguments.length>0&&void 0!==arguments[0]?arguments[0]:Number.NaN,r=arguments.length>1&&void 0!==arguments[1]?arguments[1]:Number.NaN,n=arguments.length>2&&void 0!==arguments[2]?arguments[2]:Number.NaN,o=arguments.length>3&&void 0!==arguments[3]?arguments[3]:Number.NaN;(0,F.default)(this,e),this.x1=t,this.y1=r,this.x2=n,this.y2=o,this.addPoint(t,r),this.addPoint(n,o)}return(0,U.default)(e,[{key:"addPoint",value:function(e,t){void 0!==e&&((isNaN(this.x1)||isNaN(this.x2))&&(this.x1=e,this.x2=e),e<this.x1&&(this.x1=e),e>this.x2&&(this.x2=e)),void 0!==t&&((isNaN(this.y1)||isNaN(this.y2))&&(this.y1=t,this.y2=t),t<this.y1&&(this.y1=t),t>this.y2&&(this.y2=t))}},{key:"addX",value:function(e){this.addPoint(e,null)}},{key:"addY",value:function(e){this.addPoint(null,e)}},{key:"addBoundingBox",value:function(e){if(e){var t=e.x1,r=e.y1,n=e.x2,o=e.y2;this.addPoint(t,r),this.addPoint(n,o)}}},{key:"sumCubic",value:function(e,t,r,n,o){return Math.pow(1-e,3)*t+3*Math.pow(1-e,2)*e*r+3*(1-e)*Math.pow(e,2)*n+Math.pow(e,3)*o}},{key:"bezierCurveAdd",value:function(e,t,r,n,o){var s=6*t-12*r+6*n,i=-3*t+9*r-9*n+3*o,a=3*r-3*t;if(0!==i){var A=Math.pow(s,2)-4*a*i;if(!(A<0)){var u=(-s+Math.sqrt(A))/(2*i);0<u&&u<1&&(e?this.addX(this.sumCubic(u,t,r,n,o)):this.addY(this.sumCubic(u,t,r,n,o)));var c=(-s-Math.sqrt(A))/(2*i);0<c&&c<1&&(e?this.addX(this.sumCubic(c,t,r,n,o)):this.addY(this.sumCubic(c,t,r,n,o)))}}else{if(0===s)return;var l=-a/s;0<l&&l<1&&(e?this.addX(this.sumCubic(l,t,r,n,o)):this.addY(this.sumCubic(l,t,r,n,o)))}}},{key:"addBezierCurve",value:function(e,t,r,n,o,s,i,a){this.addPoint(e,t),this.addPoint(i,a),this.bezierCurveAdd(!0,e,r,o,i),this.bezierCurveAdd(!1,t,n,s,a)}},{key:"addQuadraticCurve",value:function(e,t,r,n,o,s){var i=e+2/3*(r-e),a=t+2/3*(n-t),A=i+1/3*(o-e),u=a+1/3*(s-t);this.addBezierCurve(e,t,i,A,a,u,o,s)}},{key:"isPointInBox",value:function(e,t){var r=this.x1,n=this.y1,o=this.x2,s=this.y2;return r<=e&&e<=o&&n<=t&&t<=s}},{key:"x",get:function(){return this.x1}},{key:"y",get:function(){return this.y1}},{key:"width",get:function(){return this.x2-this.x1}},{key:"height",get:function(){return this.y2-this.y1}}]),e}();var kt=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).modifiedEmSizeStack=!1,e}return(0,U.default)(o,[{key:"calculateOpacity",value:function(){for(var e=1,t=this;t;){var r=t.getStyle("opacity",!1,!0);r.hasValue(!0)&&(e*=r.getNumber()),t=t.parent}return e}},{key:"setContext",value:function(e){var t=arguments.length>1&&void 0!==arguments[1]&&arguments[1];if(!t){var r=this.getStyle("fill"),n=this.getStyle("fill-opacity"),o=this.getStyle("stroke"),s=this.getStyle("stroke-opacity");if(r.isUrlDefinition()){var i=r.getFillStyleDefinition(this,n);i&&(e.fillStyle=i)}else if(r.hasValue()){"currentColor"===r.getString()&&r.setValue(this.getStyle("color").getColor());var a=r.getColor();"inherit"!==a&&(e.fillStyle="none"===a?"rgba(0,0,0,0)":a)}if(n.hasValue()){var A=new ht(this.document,"fill",e.fillStyle).addOpacity(n).getColor();e.fillStyle=A}if(o.isUrlDefinition()){var u=o.getFillStyleDefinition(this,s);u&&(e.strokeStyle=u)}else if(o.hasValue()){"currentColor"===o.getString()&&o.setValue(this.getStyle("color").getColor());var c=o.getString();"inherit"!==c&&(e.strokeStyle="none"===c?"rgba(0,0,0,0)":c)}if(s.hasValue()){var l=new ht(this.document,"stroke",e.strokeStyle).addOpacity(s).getString();e.strokeStyle=l}var d=this.getStyle("stroke-width");if(d.hasValue()){var f=d.getPixels();e.lineWidth=f||nt}var h=this.getStyle("stroke-linecap"),p=this.getStyle("stroke-linejoin"),m=this.getStyle("stroke-miterlimit"),g=this.getStyle("paint-order"),y=this.getStyle("stroke-dasharray"),v=this.getStyle("stroke-dashoffset");if(h.hasValue()&&(e.lineCap=h.getString()),p.hasValue()&&(e.lineJoin=p.getString()),m.hasValue()&&(e.miterLimit=m.getNumber()),g.hasValue()&&(e.paintOrder=g.getValue()),y.hasValue()&&"none"!==y.getString()){var w=Ke(y.getString());void 0!==e.setLineDash?e.setLineDash(w):void 0!==e.webkitLineDash?e.webkitLineDash=w:void 0===e.mozDash||1===w.length&&0===w[0]||(e.mozDash=w);var b=v.getPixels();void 0!==e.lineDashOffset?e.lineDashOffset=b:void 0!==e.webkitLineDashOffset?e.webkitLineDashOffset=b:void 0!==e.mozDashOffset&&(e.mozDashOffset=b)}}if(this.modifiedEmSizeStack=!1,void 0!==e.font){var B=this.getStyle("font"),j=this.getStyle("font-style"),_=this.getStyle("font-variant"),C=this.getStyle("font-weight"),x=this.getStyle("font-size"),E=this.getStyle("font-family"),N=new Pt(j.getString(),_.getString(),C.getString(),x.hasValue()?"".concat(x.getPixels(!0),"px"):"",E.getString(),Pt.parse(B.getString(),e.font));j.setValue(N.fontStyle),_.setValue(N.fontVariant),C.setValue(N.fontWeight),x.setValue(N.fontSize),E.setValue(N.fontFamily),e.font=N.toString(),x.isPixels()&&(this.document.emSize=x.getPixels(),this.modifiedEmSizeStack=!0)}t||(this.applyEffects(e),e.globalAlpha=this.calculateOpacity())}},{key:"clearContext",value:function(e){(0,de.default)((0,ee.default)(o.prototype),"clearContext",this).call(this,e),this.modifiedEmSizeStack&&this.document.popEmSize()}}]),o}(St);var Rt=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s;return(0,F.default)(this,o),(s=n.call(this,e,t,(this instanceof o?this.constructor:void 0)===o||r)).type="text",s.x=0,s.y=0,s.measureCache=-1,s}return(0,U.default)(o,[{key:"setContext",value:function(e){var t=arguments.length>1&&void 0!==arguments[1]&&arguments[1];(0,de.default)((0,ee.default)(o.prototype),"setContext",this).call(this,e,t);var r=this.getStyle("dominant-baseline").getTextBaseline()||this.getStyle("alignment-baseline").getTextBaseline();r&&(e.textBaseline=r)}},{key:"initializeCoordinates",value:function(e){this.x=this.getAttribute("x").getPixels("x"),this.y=this.getAttribute("y").getPixels("y");var t=this.getAttribute("dx"),r=this.getAttribute("dy");t.hasValue()&&(this.x+=t.getPixels("x")),r.hasValue()&&(this.y+=r.getPixels("y")),this.x+=this.getAnchorDelta(e,this,0)}},{key:"getBoundingBox",value:function(e){var t,r=this;if("text"!==this.type)return this.getTElementBoundingBox(e);this.initializeCoordinates(e);var n=null;return g()(t=this.children).call(t,(function(t,o){var s=r.getChildBoundingBox(e,r,r,o);n?n.addBoundingBox(s):n=s})),n}},{key:"getFontSize",value:function(){var e=this.document,t=this.parent,r=Pt.parse(e.ctx.font).fontSize;return t.getStyle("font-size").getNumber(r)}},{key:"getTElementBoundingBox",value:function(e){var t=this.getFontSize();return new Ot(this.x,this.y-t,this.x+this.measureText(e),this.y)}},{key:"getGlyph",value:function(e,t,r){var n=t[r],o=null;if(e.isArabic){var s=t.length,i=t[r-1],a=t[r+1],A="isolated";(0===r||" "===i)&&r<s-2&&" "!==a&&(A="terminal"),r>0&&" "!==i&&r<s-2&&" "!==a&&(A="medial"),r>0&&" "!==i&&(r===s-1||" "===a)&&(A="initial"),void 0!==e.glyphs[n]&&((o=e.glyphs[n][A])||"glyph"!==e.glyphs[n].type||(o=e.glyphs[n]))}else o=e.glyphs[n];return o||(o=e.missingGlyph),o}},{key:"getText",value:function(){return""}},{key:"getTextFromNode",value:function(e){var t=e||this.node,r=ae()(t.parentNode.childNodes),n=le()(r).call(r,t),o=r.length-1,s=Re(t.value||t.text||t.textContent||"");return 0===n&&(s=Me(s)),n===o&&(s=De(s)),s}},{key:"renderChildren",value:function(e){var t,r=this;if("text"===this.type){this.initializeCoordinates(e),g()(t=this.children).call(t,(function(t,n){r.renderChild(e,r,r,n)}));var n=this.document.screen.mouse;n.isWorking()&&n.checkBoundingBox(this,this.getBoundingBox(e))}else this.renderTElementChildren(e)}},{key:"renderTElementChildren",value:function(e){var t=this.document,r=this.parent,n=this.getText(),o=r.getStyle("font-family").getDefinition();if(o)for(var s,i=o.fontFace.unitsPerEm,a=Pt.parse(t.ctx.font),A=r.getStyle("font-size").getNumber(a.fontSize),u=r.getStyle("font-style").getString(a.fontStyle),c=A/i,l=o.isRTL?ue()(s=n.split("")).call(s).join(""):n,d=Ke(r.getAttribute("dx").getString()),f=l.length,h=0;h<f;h++){var p=this.getGlyph(o,l,h);e.translate(this.x,this.y),e.scale(c,-c);var m=e.lineWidth;e.lineWidth=e.lineWidth*i/A,"italic"===u&&e.transform(1,0,.4,1,0,0),p.render(e),"italic"===u&&e.transform(1,0,-.4,1,0,0),e.lineWidth=m,e.scale(1/c,-1/c),e.translate(-this.x,-this.y),this.x+=A*(p.horizAdvX||o.horizAdvX)/i,void 0===d[h]||isNaN(d[h])||(this.x+=d[h])}else{var g=this.x,y=this.y;"stroke"===e.paintOrder?(e.strokeStyle&&e.strokeText(n,g,y),e.fillStyle&&e.fillText(n,g,y)):(e.fillStyle&&e.fillText(n,g,y),e.strokeStyle&&e.strokeText(n,g,y))}}},{key:"getAnchorDelta",value:function(e,t,r){var n=this.getStyle("text-anchor").getString("start");if("start"!==n){for(var o=t.children,s=o.length,i=null,a=0,A=r;A<s&&(i=o[A],!(A>r&&i.getAttribute("x").hasValue()||i.getAttribute("text-anchor").hasValue()));A++)a+=i.measureTextRecursive(e);return-1*("end"===n?a:a/2)}return 0}},{key:"adjustChildCoordinates",value:function(e,t,r,n){var o=r.children[n];if("function"!=typeof o.measureText)return o;e.save(),o.setContext(e,!0);var s=o.getAttribute("x"),i=o.getAttribute("y"),a=o.getAttribute("dx"),A=o.getAttribute("dy"),u=o.getAttribute("text-anchor").getString("start");if(0===n&&"textNode"!==o.type&&(s.hasValue()||s.setValue(t.getAttribute("x").getValue("0")),i.hasValue()||i.setValue(t.getAttribute("y").getValue("0")),a.hasValue()||a.setValue(t.getAttribute("dx").getValue("0")),A.hasValue()||A.setValue(t.getAttribute("dy").getValue("0"))),s.hasValue()){if(o.x=s.getPixels("x")+t.getAnchorDelta(e,r,n),"start"!==u){var c=o.measureTextRecursive(e);o.x+=-1*("end"===u?c:c/2)}a.hasValue()&&(o.x+=a.getPixels("x"))}else{if("start"!==u){var l=o.measureTextRecursive(e);t.x+=-1*("end"===u?l:l/2)}a.hasValue()&&(t.x+=a.getPixels("x")),o.x=t.x}return t.x=o.x+o.measureText(e),i.hasValue()?(o.y=i.getPixels("y"),A.hasValue()&&(o.y+=A.getPixels("y"))):(A.hasValue()&&(t.y+=A.getPixels("y")),o.y=t.y),t.y=o.y,o.clearContext(e),e.restore(),o}},{key:"getChildBoundingBox",value:function(e,t,r,n){var o,s=this.adjustChildCoordinates(e,t,r,n);if("function"!=typeof s.getBoundingBox)return null;var i=s.getBoundingBox(e);return i?(g()(o=s.children).call(o,(function(r,n){var o=t.getChildBoundingBox(e,t,s,n);i.addBoundingBox(o)})),i):null}},{key:"renderChild",value:function(e,t,r,n){var o,s=this.adjustChildCoordinates(e,t,r,n);s.render(e),g()(o=s.children).call(o,(function(r,n){t.renderChild(e,t,s,n)}))}},{key:"measureTextRecursive",value:function(e){var t;return H()(t=this.children).call(t,(function(t,r){return t+r.measureTextRecursive(e)}),this.measureText(e))}},{key:"measureText",value:function(e){var t=this.measureCache;if(~t)return t;var r=this.getText(),n=this.measureTargetText(e,r);return this.measureCache=n,n}},{key:"measureTargetText",value:function(e,t){if(!t.length)return 0;var r=this.parent,n=r.getStyle("font-family").getDefinition();if(n){for(var o,s=this.getFontSize(),i=n.isRTL?ue()(o=t.split("")).call(o).join(""):t,a=Ke(r.getAttribute("dx").getString()),A=i.length,u=0,c=0;c<A;c++)u+=(this.getGlyph(n,i,c).horizAdvX||n.horizAdvX)*s/n.fontFace.unitsPerEm,void 0===a[c]||isNaN(a[c])||(u+=a[c]);return u}if(!e.measureText)return 10*t.length;e.save(),this.setContext(e,!0);var l=e.measureText(t).width;return this.clearContext(e),e.restore(),l}}]),o}(kt);var Mt=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s;return(0,F.default)(this,o),(s=n.call(this,e,t,(this instanceof o?this.constructor:void 0)===o||r)).type="tspan",s.text=s.children.length>0?"":s.getTextFromNode(),s}return(0,U.default)(o,[{key:"getText",value:function(){return this.text}}]),o}(Rt);var Dt=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="textNode",e}return o}(Mt);var Kt=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e){var t;return(0,F.default)(this,o),(t=n.call(this,e.replace(/[+-.]\s+/g,"-").replace(/[^MmZzLlHhVvCcSsQqTtAae\d\s.,+-].*/g,""))).control=null,t.start=null,t.current=null,t.command=null,t.commands=t.commands,t.i=-1,t.previousCommand=null,t.points=[],t.angles=[],t}return(0,U.default)(o,[{key:"reset",value:function(){this.i=-1,this.command=null,this.previousCommand=null,this.start=new mt(0,0),this.control=new mt(0,0),this.current=new mt(0,0),this.points=[],this.angles=[]}},{key:"isEnd",value:function(){return this.i>=this.commands.length-1}},{key:"next",value:function(){var e=this.commands[++this.i];return this.previousCommand=this.command,this.command=e,e}},{key:"getPoint",value:function(){var e=arguments.length>0&&void 0!==arguments[0]?arguments[0]:"x",t=arguments.length>1&&void 0!==arguments[1]?arguments[1]:"y",r=new mt(this.command[e],this.command[t]);return this.makeAbsolute(r)}},{key:"getAsControlPoint",value:function(e,t){var r=this.getPoint(e,t);return this.control=r,r}},{key:"getAsCurrentPoint",value:function(e,t){var r=this.getPoint(e,t);return this.current=r,r}},{key:"getReflectedControlPoint",value:function(){var e=this.previousCommand.type;if(e!==pe.SVGPathData.CURVE_TO&&e!==pe.SVGPathData.SMOOTH_CURVE_TO&&e!==pe.SVGPathData.QUAD_TO&&e!==pe.SVGPathData.SMOOTH_QUAD_TO)return this.current;var t=this.current,r=t.x,n=t.y,o=this.control,s=o.x,i=o.y;return new mt(2*r-s,2*n-i)}},{key:"makeAbsolute",value:function(e){if(this.command.relative){var t=this.current,r=t.x,n=t.y;e.x+=r,e.y+=n}return e}},{key:"addMarker",value:function(e,t,r){var n=this.points,o=this.angles;r&&o.length>0&&!o[o.length-1]&&(o[o.length-1]=n[n.length-1].angleTo(r)),this.addMarkerAngle(e,t?t.angleTo(e):null)}},{key:"addMarkerAngle",value:function(e,t){this.points.push(e),this.angles.push(t)}},{key:"getMarkerPoints",value:function(){return this.points}},{key:"getMarkerAngles",value:function(){for(var e=this.angles,t=e.length,r=0;r<t;r++)if(!e[r])for(var n=r+1;n<t;n++)if(e[n]){e[r]=e[n];break}return e}}]),o}(pe.SVGPathData);var zt=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s;return(0,F.default)(this,o),(s=n.call(this,e,t,r)).type="path",s.pathParser=null,s.pathParser=new Kt(s.getAttribute("d").getString()),s}return(0,U.default)(o,[{key:"path",value:function(e){var t=this.pathParser,r=new Ot;for(t.reset(),e&&e.beginPath();!t.isEnd();)switch(t.next().type){case Kt.MOVE_TO:this.pathM(e,r);break;case Kt.LINE_TO:this.pathL(e,r);break;case Kt.HORIZ_LINE_TO:this.pathH(e,r);break;case Kt.VERT_LINE_TO:this.pathV(e,r);break;case Kt.CURVE_TO:this.pathC(e,r);break;case Kt.SMOOTH_CURVE_TO:this.pathS(e,r);break;case Kt.QUAD_TO:this.pathQ(e,r);break;case Kt.SMOOTH_QUAD_TO:this.pathT(e,r);break;case Kt.ARC:this.pathA(e,r);break;case Kt.CLOSE_PATH:this.pathZ(e,r)}return r}},{key:"getBoundingBox",value:function(e){return this.path()}},{key:"getMarkers",value:function(){var e=this.pathParser,t=e.getMarkerPoints(),r=e.getMarkerAngles();return A()(t).call(t,(function(e,t){return[e,r[t]]}))}},{key:"renderChildren",value:function(e){this.path(e),this.document.screen.mouse.checkPath(this,e);var t=this.getStyle("fill-rule");""!==e.fillStyle&&("inherit"!==t.getString("inherit")?he()(e).call(e,t.getString()):he()(e).call(e)),""!==e.strokeStyle&&e.stroke();var r=this.getMarkers();if(r){var n=r.length-1,o=this.getStyle("marker-start"),s=this.getStyle("marker-mid"),i=this.getStyle("marker-end");if(o.isUrlDefinition()){var a=o.getDefinition(),A=(0,u.default)(r[0],2),c=A[0],l=A[1];a.render(e,c,l)}if(s.isUrlDefinition())for(var d=s.getDefinition(),f=1;f<n;f++){var h=(0,u.default)(r[f],2),p=h[0],m=h[1];d.render(e,p,m)}if(i.isUrlDefinition()){var g=i.getDefinition(),y=(0,u.default)(r[n],2),v=y[0],w=y[1];g.render(e,v,w)}}}},{key:"pathM",value:function(e,t){var r=this.pathParser,n=o.pathM(r).point,s=n.x,i=n.y;r.addMarker(n),t.addPoint(s,i),e&&e.moveTo(s,i)}},{key:"pathL",value:function(e,t){var r=this.pathParser,n=o.pathL(r),s=n.current,i=n.point,a=i.x,A=i.y;r.addMarker(i,s),t.addPoint(a,A),e&&e.lineTo(a,A)}},{key:"pathH",value:function(e,t){var r=this.pathParser,n=o.pathH(r),s=n.current,i=n.point,a=i.x,A=i.y;r.addMarker(i,s),t.addPoint(a,A),e&&e.lineTo(a,A)}},{key:"pathV",value:function(e,t){var r=this.pathParser,n=o.pathV(r),s=n.current,i=n.point,a=i.x,A=i.y;r.addMarker(i,s),t.addPoint(a,A),e&&e.lineTo(a,A)}},{key:"pathC",value:function(e,t){var r=this.pathParser,n=o.pathC(r),s=n.current,i=n.point,a=n.controlPoint,A=n.currentPoint;r.addMarker(A,a,i),t.addBezierCurve(s.x,s.y,i.x,i.y,a.x,a.y,A.x,A.y),e&&e.bezierCurveTo(i.x,i.y,a.x,a.y,A.x,A.y)}},{key:"pathS",value:function(e,t){var r=this.pathParser,n=o.pathS(r),s=n.current,i=n.point,a=n.controlPoint,A=n.currentPoint;r.addMarker(A,a,i),t.addBezierCurve(s.x,s.y,i.x,i.y,a.x,a.y,A.x,A.y),e&&e.bezierCurveTo(i.x,i.y,a.x,a.y,A.x,A.y)}},{key:"pathQ",value:function(e,t){var r=this.pathParser,n=o.pathQ(r),s=n.current,i=n.controlPoint,a=n.currentPoint;r.addMarker(a,i,i),t.addQuadraticCurve(s.x,s.y,i.x,i.y,a.x,a.y),e&&e.quadraticCurveTo(i.x,i.y,a.x,a.y)}},{key:"pathT",value:function(e,t){var r=this.pathParser,n=o.pathT(r),s=n.current,i=n.controlPoint,a=n.currentPoint;r.addMarker(a,i,i),t.addQuadraticCurve(s.x,s.y,i.x,i.y,a.x,a.y),e&&e.quadraticCurveTo(i.x,i.y,a.x,a.y)}},{key:"pathA",value:function(e,t){var r=this.pathParser,n=o.pathA(r),s=n.currentPoint,i=n.rX,a=n.rY,A=n.sweepFlag,u=n.xAxisRotation,c=n.centp,l=n.a1,d=n.ad,f=1-A?1:-1,h=l+f*(d/2),p=new mt(c.x+i*Math.cos(h),c.y+a*Math.sin(h));if(r.addMarkerAngle(p,h-f*Math.PI/2),r.addMarkerAngle(s,h-f*Math.PI),t.addPoint(s.x,s.y),e&&!isNaN(l)&&!isNaN(d)){var m=i>a?i:a,g=i>a?1:i/a,y=i>a?a/i:1;e.translate(c.x,c.y),e.rotate(u),e.scale(g,y),e.arc(0,0,m,l,l+d,Boolean(1-A)),e.scale(1/g,1/y),e.rotate(-u),e.translate(-c.x,-c.y)}}},{key:"pathZ",value:function(e,t){o.pathZ(this.pathParser),e&&t.x1!==t.x2&&t.y1!==t.y2&&e.closePath()}}],[{key:"pathM",value:function(e){var t=e.getAsCurrentPoint();return e.start=e.current,{point:t}}},{key:"pathL",value:function(e){return{current:e.current,point:e.getAsCurrentPoint()}}},{key:"pathH",value:function(e){var t=e.current,r=e.command,n=new mt((r.relative?t.x:0)+r.x,t.y);return e.current=n,{current:t,point:n}}},{key:"pathV",value:function(e){var t=e.current,r=e.command,n=new mt(t.x,(r.relative?t.y:0)+r.y);return e.current=n,{current:t,point:n}}},{key:"pathC",value:function(e){return{current:e.current,point:e.getPoint("x1","y1"),controlPoint:e.getAsControlPoint("x2","y2"),currentPoint:e.getAsCurrentPoint()}}},{key:"pathS",value:function(e){return{current:e.current,point:e.getReflectedControlPoint(),controlPoint:e.getAsControlPoint("x2","y2"),currentPoint:e.getAsCurrentPoint()}}},{key:"pathQ",value:function(e){return{current:e.current,controlPoint:e.getAsControlPoint("x1","y1"),currentPoint:e.getAsCurrentPoint()}}},{key:"pathT",value:function(e){var t=e.current,r=e.getReflectedControlPoint();return e.control=r,{current:t,controlPoint:r,currentPoint:e.getAsCurrentPoint()}}},{key:"pathA",value:function(e){var t=e.current,r=e.command,n=r.rX,o=r.rY,s=r.xRot,i=r.lArcFlag,a=r.sweepFlag,A=s*(Math.PI/180),u=e.getAsCurrentPoint(),c=new mt(Math.cos(A)*(t.x-u.x)/2+Math.sin(A)*(t.y-u.y)/2,-Math.sin(A)*(t.x-u.x)/2+Math.cos(A)*(t.y-u.y)/2),l=Math.pow(c.x,2)/Math.pow(n,2)+Math.pow(c.y,2)/Math.pow(o,2);l>1&&(n*=Math.sqrt(l),o*=Math.sqrt(l));var d=(i===a?-1:1)*Math.sqrt((Math.pow(n,2)*Math.pow(o,2)-Math.pow(n,2)*Math.pow(c.y,2)-Math.pow(o,2)*Math.pow(c.x,2))/(Math.pow(n,2)*Math.pow(c.y,2)+Math.pow(o,2)*Math.pow(c.x,2)));isNaN(d)&&(d=0);var f=new mt(d*n*c.y/o,d*-o*c.x/n),h=new mt((t.x+u.x)/2+Math.cos(A)*f.x-Math.sin(A)*f.y,(t.y+u.y)/2+Math.sin(A)*f.x+Math.cos(A)*f.y),p=it([1,0],[(c.x-f.x)/n,(c.y-f.y)/o]),m=[(c.x-f.x)/n,(c.y-f.y)/o],g=[(-c.x-f.x)/n,(-c.y-f.y)/o],y=it(m,g);return st(m,g)<=-1&&(y=Math.PI),st(m,g)>=1&&(y=0),{currentPoint:u,rX:n,rY:o,sweepFlag:a,xAxisRotation:A,centp:h,a1:p,ad:y}}},{key:"pathZ",value:function(e){e.current=e.start}}]),o}(kt);var Vt=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="svg",e.root=!1,e}return(0,U.default)(o,[{key:"setContext",value:function(e){var t=this.document,r=t.screen,n=t.window,s=e.canvas;if(r.setDefaults(e),s.style&&void 0!==e.font&&n&&void 0!==n.getComputedStyle){e.font=n.getComputedStyle(s).getPropertyValue("font");var i=new ht(t,"fontSize",Pt.parse(e.font).fontSize);i.hasValue()&&(t.rootEmSize=i.getPixels("y"),t.emSize=t.rootEmSize)}this.getAttribute("x").hasValue()||this.getAttribute("x",!0).setValue(0),this.getAttribute("y").hasValue()||this.getAttribute("y",!0).setValue(0);var a=r.viewPort,A=a.width,u=a.height;this.getStyle("width").hasValue()||this.getStyle("width",!0).setValue("100%"),this.getStyle("height").hasValue()||this.getStyle("height",!0).setValue("100%"),this.getStyle("color").hasValue()||this.getStyle("color",!0).setValue("black");var c=this.getAttribute("refX"),l=this.getAttribute("refY"),d=this.getAttribute("viewBox"),f=d.hasValue()?Ke(d.getString()):null,h=!this.root&&"visible"!==this.getStyle("overflow").getValue("hidden"),p=0,m=0,g=0,y=0;f&&(p=f[0],m=f[1]),this.root||(A=this.getStyle("width").getPixels("x"),u=this.getStyle("height").getPixels("y"),"marker"===this.type&&(g=p,y=m,p=0,m=0)),r.viewPort.setCurrent(A,u),this.node&&this.getStyle("transform",!1,!0).hasValue()&&!this.getStyle("transform-origin",!1,!0).hasValue()&&this.getStyle("transform-origin",!0,!0).setValue("50% 50%"),(0,de.default)((0,ee.default)(o.prototype),"setContext",this).call(this,e),e.translate(this.getAttribute("x").getPixels("x"),this.getAttribute("y").getPixels("y")),f&&(A=f[2],u=f[3]),t.setViewBox({ctx:e,aspectRatio:this.getAttribute("preserveAspectRatio").getString(),width:r.viewPort.width,desiredWidth:A,height:r.viewPort.height,desiredHeight:u,minX:p,minY:m,refX:c.getValue(),refY:l.getValue(),clip:h,clipX:g,clipY:y}),f&&(r.viewPort.removeCurrent(),r.viewPort.setCurrent(A,u))}},{key:"clearContext",value:function(e){(0,de.default)((0,ee.default)(o.prototype),"clearContext",this).call(this,e),this.document.screen.viewPort.removeCurrent()}},{key:"resize",value:function(e){var t,r=arguments.length>1&&void 0!==arguments[1]?arguments[1]:e,n=arguments.length>2&&void 0!==arguments[2]&&arguments[2],o=this.getAttribute("width",!0),s=this.getAttribute("height",!0),i=this.getAttribute("viewBox"),a=this.getAttribute("style"),A=o.getNumber(0),u=s.getNumber(0);if(n)if("string"==typeof n)this.getAttribute("preserveAspectRatio",!0).setValue(n);else{var c=this.getAttribute("preserveAspectRatio");c.hasValue()&&c.setValue(c.getString().replace(/^\s*(\S.*\S)\s*$/,"$1"))}if(o.setValue(e),s.setValue(r),i.hasValue()||i.setValue(L()(t="0 0 ".concat(A||e," ")).call(t,u||r)),a.hasValue()){var l=this.getStyle("width"),d=this.getStyle("height");l.hasValue()&&l.setValue("".concat(e,"px")),d.hasValue()&&d.setValue("".concat(r,"px"))}}}]),o}(kt);var qt=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="rect",e}return(0,U.default)(o,[{key:"path",value:function(e){var t=this.getAttribute("x").getPixels("x"),r=this.getAttribute("y").getPixels("y"),n=this.getStyle("width",!1,!0).getPixels("x"),o=this.getStyle("height",!1,!0).getPixels("y"),s=this.getAttribute("rx"),i=this.getAttribute("ry"),a=s.getPixels("x"),A=i.getPixels("y");if(s.hasValue()&&!i.hasValue()&&(A=a),i.hasValue()&&!s.hasValue()&&(a=A),a=Math.min(a,n/2),A=Math.min(A,o/2),e){var u=(Math.sqrt(2)-1)/3*4;e.beginPath(),o>0&&n>0&&(e.moveTo(t+a,r),e.lineTo(t+n-a,r),e.bezierCurveTo(t+n-a+u*a,r,t+n,r+A-u*A,t+n,r+A),e.lineTo(t+n,r+o-A),e.bezierCurveTo(t+n,r+o-A+u*A,t+n-a+u*a,r+o,t+n-a,r+o),e.lineTo(t+a,r+o),e.bezierCurveTo(t+a-u*a,r+o,t,r+o-A+u*A,t,r+o-A),e.lineTo(t,r+A),e.bezierCurveTo(t,r+A-u*A,t+a-u*a,r,t+a,r),e.closePath())}return new Ot(t,r,t+n,r+o)}},{key:"getMarkers",value:function(){return null}}]),o}(zt);var Gt=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="circle",e}return(0,U.default)(o,[{key:"path",value:function(e){var t=this.getAttribute("cx").getPixels("x"),r=this.getAttribute("cy").getPixels("y"),n=this.getAttribute("r").getPixels();return e&&n>0&&(e.beginPath(),e.arc(t,r,n,0,2*Math.PI,!1),e.closePath()),new Ot(t-n,r-n,t+n,r+n)}},{key:"getMarkers",value:function(){return null}}]),o}(zt);var Xt=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="ellipse",e}return(0,U.default)(o,[{key:"path",value:function(e){var t=(Math.sqrt(2)-1)/3*4,r=this.getAttribute("rx").getPixels("x"),n=this.getAttribute("ry").getPixels("y"),o=this.getAttribute("cx").getPixels("x"),s=this.getAttribute("cy").getPixels("y");return e&&r>0&&n>0&&(e.beginPath(),e.moveTo(o+r,s),e.bezierCurveTo(o+r,s+t*n,o+t*r,s+n,o,s+n),e.bezierCurveTo(o-t*r,s+n,o-r,s+t*n,o-r,s),e.bezierCurveTo(o-r,s-t*n,o-t*r,s-n,o,s-n),e.bezierCurveTo(o+t*r,s-n,o+r,s-t*n,o+r,s),e.closePath()),new Ot(o-r,s-n,o+r,s+n)}},{key:"getMarkers",value:function(){return null}}]),o}(zt);var Wt=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="line",e}return(0,U.default)(o,[{key:"getPoints",value:function(){return[new mt(this.getAttribute("x1").getPixels("x"),this.getAttribute("y1").getPixels("y")),new mt(this.getAttribute("x2").getPixels("x"),this.getAttribute("y2").getPixels("y"))]}},{key:"path",value:function(e){var t=this.getPoints(),r=(0,u.default)(t,2),n=r[0],o=n.x,s=n.y,i=r[1],a=i.x,A=i.y;return e&&(e.beginPath(),e.moveTo(o,s),e.lineTo(a,A)),new Ot(o,s,a,A)}},{key:"getMarkers",value:function(){var e=this.getPoints(),t=(0,u.default)(e,2),r=t[0],n=t[1],o=r.angleTo(n);return[[r,o],[n,o]]}}]),o}(zt);var Jt=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s;return(0,F.default)(this,o),(s=n.call(this,e,t,r)).type="polyline",s.points=[],s.points=mt.parsePath(s.getAttribute("points").getString()),s}return(0,U.default)(o,[{key:"path",value:function(e){var t=this.points,r=(0,u.default)(t,1)[0],n=r.x,o=r.y,s=new Ot(n,o);return e&&(e.beginPath(),e.moveTo(n,o)),g()(t).call(t,(function(t){var r=t.x,n=t.y;s.addPoint(r,n),e&&e.lineTo(r,n)})),s}},{key:"getMarkers",value:function(){var e=this.points,t=e.length-1,r=[];return g()(e).call(e,(function(n,o){o!==t&&r.push([n,n.angleTo(e[o+1])])})),r.length>0&&r.push([e[e.length-1],r[r.length-1][1]]),r}}]),o}(zt);var Yt=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="polygon",e}return(0,U.default)(o,[{key:"path",value:function(e){var t=(0,de.default)((0,ee.default)(o.prototype),"path",this).call(this,e),r=(0,u.default)(this.points,1)[0],n=r.x,s=r.y;return e&&(e.lineTo(n,s),e.closePath()),t}}]),o}(Jt);var Zt=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="pattern",e}return(0,U.default)(o,[{key:"createPattern",value:function(e,t,r){var n=this.getStyle("width").getPixels("x",!0),o=this.getStyle("height").getPixels("y",!0),s=new Vt(this.document,null);s.attributes.viewBox=new ht(this.document,"viewBox",this.getAttribute("viewBox").getValue()),s.attributes.width=new ht(this.document,"width","".concat(n,"px")),s.attributes.height=new ht(this.document,"height","".concat(o,"px")),s.attributes.transform=new ht(this.document,"transform",this.getAttribute("patternTransform").getValue()),s.children=this.children;var i=this.document.createCanvas(n,o),a=i.getContext("2d"),A=this.getAttribute("x"),u=this.getAttribute("y");A.hasValue()&&u.hasValue()&&a.translate(A.getPixels("x",!0),u.getPixels("y",!0)),r.hasValue()?this.styles["fill-opacity"]=r:ge()(this.styles,"fill-opacity");for(var c=-1;c<=1;c++)for(var l=-1;l<=1;l++)a.save(),s.attributes.x=new ht(this.document,"x",c*i.width),s.attributes.y=new ht(this.document,"y",l*i.height),s.render(a),a.restore();return e.createPattern(i,"repeat")}}]),o}(St);var $t=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="marker",e}return(0,U.default)(o,[{key:"render",value:function(e,t,r){if(t){var n=t.x,o=t.y,s=this.getAttribute("orient").getValue("auto"),i=this.getAttribute("markerUnits").getValue("strokeWidth");e.translate(n,o),"auto"===s&&e.rotate(r),"strokeWidth"===i&&e.scale(e.lineWidth,e.lineWidth),e.save();var a=new Vt(this.document,null);a.type=this.type,a.attributes.viewBox=new ht(this.document,"viewBox",this.getAttribute("viewBox").getValue()),a.attributes.refX=new ht(this.document,"refX",this.getAttribute("refX").getValue()),a.attributes.refY=new ht(this.document,"refY",this.getAttribute("refY").getValue()),a.attributes.width=new ht(this.document,"width",this.getAttribute("markerWidth").getValue()),a.attributes.height=new ht(this.document,"height",this.getAttribute("markerHeight").getValue()),a.attributes.overflow=new ht(this.document,"overflow",this.getAttribute("overflow").getValue()),a.attributes.fill=new ht(this.document,"fill",this.getAttribute("fill").getColor("black")),a.attributes.stroke=new ht(this.document,"stroke",this.getAttribute("stroke").getValue("none")),a.children=this.children,a.render(e),e.restore(),"strokeWidth"===i&&e.scale(1/e.lineWidth,1/e.lineWidth),"auto"===s&&e.rotate(-r),e.translate(-n,-o)}}}]),o}(St);var er=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="defs",e}return(0,U.default)(o,[{key:"render",value:function(){}}]),o}(St);var tr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="g",e}return(0,U.default)(o,[{key:"getBoundingBox",value:function(e){var t,r=new Ot;return g()(t=this.children).call(t,(function(t){r.addBoundingBox(t.getBoundingBox(e))})),r}}]),o}(kt);var rr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s;(0,F.default)(this,o),(s=n.call(this,e,t,r)).attributesToInherit=["gradientUnits"],s.stops=[];var i=(0,ye.default)(s),a=i.stops,A=i.children;return g()(A).call(A,(function(e){"stop"===e.type&&a.push(e)})),s}return(0,U.default)(o,[{key:"getGradientUnits",value:function(){return this.getAttribute("gradientUnits").getString("objectBoundingBox")}},{key:"createGradient",value:function(e,t,r){var n=this,o=this;this.getHrefAttribute().hasValue()&&(o=this.getHrefAttribute().getDefinition(),this.inheritStopContainer(o));var s=o.stops,i=this.getGradient(e,t);if(!i)return this.addParentOpacity(r,s[s.length-1].color);if(g()(s).call(s,(function(e){i.addColorStop(e.offset,n.addParentOpacity(r,e.color))})),this.getAttribute("gradientTransform").hasValue()){var a=this.document,A=a.screen,c=A.MAX_VIRTUAL_PIXELS,l=A.viewPort,d=(0,u.default)(l.viewPorts,1)[0],f=new qt(a,null);f.attributes.x=new ht(a,"x",-c/3),f.attributes.y=new ht(a,"y",-c/3),f.attributes.width=new ht(a,"width",c),f.attributes.height=new ht(a,"height",c);var h=new tr(a,null);h.attributes.transform=new ht(a,"transform",this.getAttribute("gradientTransform").getValue()),h.children=[f];var p=new Vt(a,null);p.attributes.x=new ht(a,"x",0),p.attributes.y=new ht(a,"y",0),p.attributes.width=new ht(a,"width",d.width),p.attributes.height=new ht(a,"height",d.height),p.children=[h];var m=a.createCanvas(d.width,d.height),y=m.getContext("2d");return y.fillStyle=i,p.render(y),y.createPattern(m,"no-repeat")}return i}},{key:"inheritStopContainer",value:function(e){var t,r=this;g()(t=this.attributesToInherit).call(t,(function(t){!r.getAttribute(t).hasValue()&&e.getAttribute(t).hasValue()&&r.getAttribute(t,!0).setValue(e.getAttribute(t).getValue())}))}},{key:"addParentOpacity",value:function(e,t){return e.hasValue()?new ht(this.document,"color",t).addOpacity(e).getColor():t}}]),o}(St);var nr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s;return(0,F.default)(this,o),(s=n.call(this,e,t,r)).type="linearGradient",s.attributesToInherit.push("x1","y1","x2","y2"),s}return(0,U.default)(o,[{key:"getGradient",value:function(e,t){var r="objectBoundingBox"===this.getGradientUnits(),n=r?t.getBoundingBox(e):null;if(r&&!n)return null;this.getAttribute("x1").hasValue()||this.getAttribute("y1").hasValue()||this.getAttribute("x2").hasValue()||this.getAttribute("y2").hasValue()||(this.getAttribute("x1",!0).setValue(0),this.getAttribute("y1",!0).setValue(0),this.getAttribute("x2",!0).setValue(1),this.getAttribute("y2",!0).setValue(0));var o=r?n.x+n.width*this.getAttribute("x1").getNumber():this.getAttribute("x1").getPixels("x"),s=r?n.y+n.height*this.getAttribute("y1").getNumber():this.getAttribute("y1").getPixels("y"),i=r?n.x+n.width*this.getAttribute("x2").getNumber():this.getAttribute("x2").getPixels("x"),a=r?n.y+n.height*this.getAttribute("y2").getNumber():this.getAttribute("y2").getPixels("y");return o===i&&s===a?null:e.createLinearGradient(o,s,i,a)}}]),o}(rr);var or=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s;return(0,F.default)(this,o),(s=n.call(this,e,t,r)).type="radialGradient",s.attributesToInherit.push("cx","cy","r","fx","fy","fr"),s}return(0,U.default)(o,[{key:"getGradient",value:function(e,t){var r="objectBoundingBox"===this.getGradientUnits(),n=t.getBoundingBox(e);if(r&&!n)return null;this.getAttribute("cx").hasValue()||this.getAttribute("cx",!0).setValue("50%"),this.getAttribute("cy").hasValue()||this.getAttribute("cy",!0).setValue("50%"),this.getAttribute("r").hasValue()||this.getAttribute("r",!0).setValue("50%");var o=r?n.x+n.width*this.getAttribute("cx").getNumber():this.getAttribute("cx").getPixels("x"),s=r?n.y+n.height*this.getAttribute("cy").getNumber():this.getAttribute("cy").getPixels("y"),i=o,a=s;this.getAttribute("fx").hasValue()&&(i=r?n.x+n.width*this.getAttribute("fx").getNumber():this.getAttribute("fx").getPixels("x")),this.getAttribute("fy").hasValue()&&(a=r?n.y+n.height*this.getAttribute("fy").getNumber():this.getAttribute("fy").getPixels("y"));var A=r?(n.width+n.height)/2*this.getAttribute("r").getNumber():this.getAttribute("r").getPixels(),u=this.getAttribute("fr").getPixels();return e.createRadialGradient(i,a,u,o,s,A)}}]),o}(rr);var sr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s;(0,F.default)(this,o),(s=n.call(this,e,t,r)).type="stop";var i=Math.max(0,Math.min(1,s.getAttribute("offset").getNumber())),a=s.getStyle("stop-opacity"),A=s.getStyle("stop-color",!0);return""===A.getString()&&A.setValue("#000"),a.hasValue()&&(A=A.addOpacity(a)),s.offset=i,s.color=A.getColor(),s}return o}(St);var ir=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s;return(0,F.default)(this,o),(s=n.call(this,e,t,r)).type="animate",s.duration=0,s.initialValue=null,s.initialUnits="",s.removed=!1,s.frozen=!1,e.screen.animations.push((0,ye.default)(s)),s.begin=s.getAttribute("begin").getMilliseconds(),s.maxDuration=s.begin+s.getAttribute("dur").getMilliseconds(),s.from=s.getAttribute("from"),s.to=s.getAttribute("to"),s.values=s.getAttribute("values"),we()(s).hasValue()&&we()(s).setValue(we()(s).getString().split(";")),s}return(0,U.default)(o,[{key:"getProperty",value:function(){var e=this.getAttribute("attributeType").getString(),t=this.getAttribute("attributeName").getString();return"CSS"===e?this.parent.getStyle(t,!0):this.parent.getAttribute(t,!0)}},{key:"calcValue",value:function(){var e,t=this.initialUnits,r=this.getProgress(),n=r.progress,o=r.from,s=r.to,i=o.getNumber()+(s.getNumber()-o.getNumber())*n;return"%"===t&&(i*=100),L()(e="".concat(i)).call(e,t)}},{key:"update",value:function(e){var t=this.parent,r=this.getProperty();if(this.initialValue||(this.initialValue=r.getString(),this.initialUnits=r.getUnits()),this.duration>this.maxDuration){var n=this.getAttribute("fill").getString("remove");if("indefinite"===this.getAttribute("repeatCount").getString()||"indefinite"===this.getAttribute("repeatDur").getString())this.duration=0;else if("freeze"!==n||this.frozen){if("remove"===n&&!this.removed)return this.removed=!0,r.setValue(t.animationFrozen?t.animationFrozenValue:this.initialValue),!0}else this.frozen=!0,t.animationFrozen=!0,t.animationFrozenValue=r.getString();return!1}this.duration+=e;var o=!1;if(this.begin<this.duration){var s=this.calcValue(),i=this.getAttribute("type");if(i.hasValue()){var a,A=i.getString();s=L()(a="".concat(A,"(")).call(a,s,")")}r.setValue(s),o=!0}return o}},{key:"getProgress",value:function(){var e=this.document,t=we()(this),r={progress:(this.duration-this.begin)/(this.maxDuration-this.begin)};if(t.hasValue()){var n=r.progress*(t.getValue().length-1),o=Math.floor(n),s=Math.ceil(n);r.from=new ht(e,"from",i()(t.getValue()[o])),r.to=new ht(e,"to",i()(t.getValue()[s])),r.progress=(n-o)/(s-o)}else r.from=this.from,r.to=this.to;return r}}]),o}(St);var ar=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="animateColor",e}return(0,U.default)(o,[{key:"calcValue",value:function(){var e=this.getProgress(),t=e.progress,r=e.from,n=e.to,o=new(W())(r.getColor()),s=new(W())(n.getColor());if(o.ok&&s.ok){var i,a,A=o.r+(s.r-o.r)*t,u=o.g+(s.g-o.g)*t,c=o.b+(s.b-o.b)*t;return L()(i=L()(a="rgb(".concat(Be()(A,10),", ")).call(a,Be()(u,10),", ")).call(i,Be()(c,10),")")}return this.getAttribute("from").getColor()}}]),o}(ir);var Ar=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="animateTransform",e}return(0,U.default)(o,[{key:"calcValue",value:function(){var e=this.getProgress(),t=e.progress,r=e.from,n=e.to,o=Ke(r.getString()),s=Ke(n.getString());return A()(o).call(o,(function(e,r){return e+(s[r]-e)*t})).join(" ")}}]),o}(ir);function ur(e,t){(null==t||t>e.length)&&(t=e.length);for(var r=0,n=new Array(t);r<t;r++)n[r]=e[r];return n}var cr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s;(0,F.default)(this,o),(s=n.call(this,e,t,r)).type="font",s.glyphs={},s.horizAdvX=s.getAttribute("horiz-adv-x").getNumber();var i,a=e.definitions,A=function(e,t){var r;if(void 0===Fe()||null==Ne()(e)){if(xe()(e)||(r=function(e,t){var r;if(e){if("string"==typeof e)return ur(e,t);var n=Se()(r=Object.prototype.toString.call(e)).call(r,8,-1);return"Object"===n&&e.constructor&&(n=e.constructor.name),"Map"===n||"Set"===n?ae()(e):"Arguments"===n||/^(?:Ui|I)nt(?:8|16|32)(?:Clamped)?Array$/.test(n)?ur(e,t):void 0}}(e))||t&&e&&"number"==typeof e.length){r&&(e=r);var n=0,o=function(){};return{s:o,n:function(){return n>=e.length?{done:!0}:{done:!1,value:e[n++]}},e:function(e){throw e},f:o}}throw new TypeError("Invalid attempt to iterate non-iterable instance.\nIn order to be iterable, non-array objects must have a [Symbol.iterator]() method.")}var s,i=!0,a=!1;return{s:function(){r=_e()(e)},n:function(){var e=r.next();return i=e.done,e},e:function(e){a=!0,s=e},f:function(){try{i||null==r.return||r.return()}finally{if(a)throw s}}}}((0,ye.default)(s).children);try{for(A.s();!(i=A.n()).done;){var u=i.value;switch(u.type){case"font-face":s.fontFace=u;var c=u.getStyle("font-family");c.hasValue()&&(a[c.getString()]=(0,ye.default)(s));break;case"missing-glyph":s.missingGlyph=u;break;case"glyph":var l=u;l.arabicForm?(s.isRTL=!0,s.isArabic=!0,void 0===s.glyphs[l.unicode]&&(s.glyphs[l.unicode]={}),s.glyphs[l.unicode][l.arabicForm]=l):s.glyphs[l.unicode]=l}}}catch(e){A.e(e)}finally{A.f()}return s}return(0,U.default)(o,[{key:"render",value:function(){}}]),o}(St);var lr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s;return(0,F.default)(this,o),(s=n.call(this,e,t,r)).type="font-face",s.ascent=s.getAttribute("ascent").getNumber(),s.descent=s.getAttribute("descent").getNumber(),s.unitsPerEm=s.getAttribute("units-per-em").getNumber(),s}return o}(St);var dr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="missing-glyph",e.horizAdvX=0,e}return o}(zt);var fr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s;return(0,F.default)(this,o),(s=n.call(this,e,t,r)).type="glyph",s.horizAdvX=s.getAttribute("horiz-adv-x").getNumber(),s.unicode=s.getAttribute("unicode").getString(),s.arabicForm=s.getAttribute("arabic-form").getString(),s}return o}(zt);var hr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="tref",e}return(0,U.default)(o,[{key:"getText",value:function(){var e=this.getHrefAttribute().getDefinition();if(e){var t=e.children[0];if(t)return t.getText()}return""}}]),o}(Rt);var pr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s,i;(0,F.default)(this,o),(i=n.call(this,e,t,r)).type="a";var a=t.childNodes,A=a[0],u=a.length>0&&k()(s=ae()(a)).call(s,(function(e){return 3===e.nodeType}));return i.hasText=u,i.text=u?i.getTextFromNode(A):"",i}return(0,U.default)(o,[{key:"getText",value:function(){return this.text}},{key:"renderChildren",value:function(e){if(this.hasText){(0,de.default)((0,ee.default)(o.prototype),"renderChildren",this).call(this,e);var t=this.document,r=this.x,n=this.y,s=t.screen.mouse,i=new ht(t,"fontSize",Pt.parse(t.ctx.font).fontSize);s.isWorking()&&s.checkBoundingBox(this,new Ot(r,n-i.getPixels("y"),r+this.measureText(e),n))}else if(this.children.length>0){var a=new tr(this.document,null);a.children=this.children,a.parent=this,a.render(e)}}},{key:"onClick",value:function(){var e=this.document.window;e&&e.open(this.getHrefAttribute().getString())}},{key:"onMouseMove",value:function(){this.document.ctx.canvas.style.cursor="pointer"}}]),o}(Rt);function mr(e,t){(null==t||t>e.length)&&(t=e.length);for(var r=0,n=new Array(t);r<t;r++)n[r]=e[r];return n}function gr(e,t){var r=C()(e);if(j()){var n=j()(e);t&&(n=b()(n).call(n,(function(t){return v()(e,t).enumerable}))),r.push.apply(r,n)}return r}function yr(e){for(var t=1;t<arguments.length;t++){var r,n=null!=arguments[t]?arguments[t]:{};if(t%2)g()(r=gr(Object(n),!0)).call(r,(function(t){(0,Q.default)(e,t,n[t])}));else if(p())f()(e,p()(n));else{var o;g()(o=gr(Object(n))).call(o,(function(t){l()(e,t,v()(n,t))}))}}return e}var vr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s;(0,F.default)(this,o),(s=n.call(this,e,t,r)).type="textPath",s.textWidth=0,s.textHeight=0,s.pathLength=-1,s.glyphInfo=null,s.letterSpacingCache=[],s.measuresCache=new(Te())([["",0]]);var i=s.getHrefAttribute().getDefinition();return s.text=s.getTextFromNode(),s.dataArray=s.parsePathData(i),s}return(0,U.default)(o,[{key:"getText",value:function(){return this.text}},{key:"path",value:function(e){var t=this.dataArray;e&&e.beginPath(),g()(t).call(t,(function(t){var r=t.type,n=t.points;switch(r){case Kt.LINE_TO:e&&e.lineTo(n[0],n[1]);break;case Kt.MOVE_TO:e&&e.moveTo(n[0],n[1]);break;case Kt.CURVE_TO:e&&e.bezierCurveTo(n[0],n[1],n[2],n[3],n[4],n[5]);break;case Kt.QUAD_TO:e&&e.quadraticCurveTo(n[0],n[1],n[2],n[3]);break;case Kt.ARC:var o=(0,u.default)(n,8),s=o[0],i=o[1],a=o[2],A=o[3],c=o[4],l=o[5],d=o[6],f=o[7],h=a>A?a:A,p=a>A?1:a/A,m=a>A?A/a:1;e&&(e.translate(s,i),e.rotate(d),e.scale(p,m),e.arc(0,0,h,c,c+l,Boolean(1-f)),e.scale(1/p,1/m),e.rotate(-d),e.translate(-s,-i));break;case Kt.CLOSE_PATH:e&&e.closePath()}}))}},{key:"renderChildren",value:function(e){this.setTextData(e),e.save();var t=this.parent.getStyle("text-decoration").getString(),r=this.getFontSize(),n=this.glyphInfo,o=e.fillStyle;"underline"===t&&e.beginPath(),g()(n).call(n,(function(n,o){var s=n.p0,i=n.p1,a=n.rotation,A=n.text;e.save(),e.translate(s.x,s.y),e.rotate(a),e.fillStyle&&e.fillText(A,0,0),e.strokeStyle&&e.strokeText(A,0,0),e.restore(),"underline"===t&&(0===o&&e.moveTo(s.x,s.y+r/8),e.lineTo(i.x,i.y+r/5))})),"underline"===t&&(e.lineWidth=r/20,e.strokeStyle=o,e.stroke(),e.closePath()),e.restore()}},{key:"getLetterSpacingAt",value:function(){var e=arguments.length>0&&void 0!==arguments[0]?arguments[0]:0;return this.letterSpacingCache[e]||0}},{key:"findSegmentToFitChar",value:function(e,t,r,n,o,s,i,a,A){var u=s,c=this.measureText(e,a);" "===a&&"justify"===t&&r<n&&(c+=(n-r)/o),A>-1&&(u+=this.getLetterSpacingAt(A));var l=this.textHeight/20,d=this.getEquidistantPointOnPath(u,l,0),f=this.getEquidistantPointOnPath(u+c,l,0),h={p0:d,p1:f},p=d&&f?Math.atan2(f.y-d.y,f.x-d.x):0;if(i){var m=Math.cos(Math.PI/2+p)*i,g=Math.cos(-p)*i;h.p0=yr(yr({},d),{},{x:d.x+m,y:d.y+g}),h.p1=yr(yr({},f),{},{x:f.x+m,y:f.y+g})}return{offset:u+=c,segment:h,rotation:p}}},{key:"measureText",value:function(e,t){var r=this.measuresCache,n=t||this.getText();if(r.has(n))return r.get(n);var o=this.measureTargetText(e,n);return r.set(n,o),o}},{key:"setTextData",value:function(e){var t,r=this;if(!this.glyphInfo){var n=this.getText(),o=n.split(""),s=n.split(" ").length-1,i=A()(t=this.parent.getAttribute("dx").split()).call(t,(function(e){return e.getPixels("x")})),a=this.parent.getAttribute("dy").getPixels("y"),u=this.parent.getStyle("text-anchor").getString("start"),c=this.getStyle("letter-spacing"),l=this.parent.getStyle("letter-spacing"),d=0;c.hasValue()&&"inherit"!==c.getValue()?c.hasValue()&&"initial"!==c.getValue()&&"unset"!==c.getValue()&&(d=c.getPixels()):d=l.getPixels();var f=[],h=n.length;this.letterSpacingCache=f;for(var p=0;p<h;p++)f.push(void 0!==i[p]?i[p]:d);var m=H()(f).call(f,(function(e,t,r){return 0===r?0:e+t||0}),0),y=this.measureText(e),v=Math.max(y+m,0);this.textWidth=y,this.textHeight=this.getFontSize(),this.glyphInfo=[];var w=this.getPathLength(),b=this.getStyle("startOffset").getNumber(0)*w,B=0;"middle"!==u&&"center"!==u||(B=-v/2),"end"!==u&&"right"!==u||(B=-v),B+=b,g()(o).call(o,(function(t,n){var i=r.findSegmentToFitChar(e,u,v,w,s,B,a,t,n),A=i.offset,c=i.segment,l=i.rotation;B=A,c.p0&&c.p1&&r.glyphInfo.push({text:o[n],p0:c.p0,p1:c.p1,rotation:l})}))}}},{key:"parsePathData",value:function(e){if(this.pathLength=-1,!e)return[];var t=[],r=e.pathParser;for(r.reset();!r.isEnd();){var n=r.current,o=n?n.x:0,s=n?n.y:0,i=r.next(),a=i.type,A=[];switch(i.type){case Kt.MOVE_TO:this.pathM(r,A);break;case Kt.LINE_TO:a=this.pathL(r,A);break;case Kt.HORIZ_LINE_TO:a=this.pathH(r,A);break;case Kt.VERT_LINE_TO:a=this.pathV(r,A);break;case Kt.CURVE_TO:this.pathC(r,A);break;case Kt.SMOOTH_CURVE_TO:a=this.pathS(r,A);break;case Kt.QUAD_TO:this.pathQ(r,A);break;case Kt.SMOOTH_QUAD_TO:a=this.pathT(r,A);break;case Kt.ARC:A=this.pathA(r);break;case Kt.CLOSE_PATH:zt.pathZ(r)}i.type!==Kt.CLOSE_PATH?t.push({type:a,points:A,start:{x:o,y:s},pathLength:this.calcLength(o,s,a,A)}):t.push({type:Kt.CLOSE_PATH,points:[],pathLength:0})}return t}},{key:"pathM",value:function(e,t){var r=zt.pathM(e).point,n=r.x,o=r.y;t.push(n,o)}},{key:"pathL",value:function(e,t){var r=zt.pathL(e).point,n=r.x,o=r.y;return t.push(n,o),Kt.LINE_TO}},{key:"pathH",value:function(e,t){var r=zt.pathH(e).point,n=r.x,o=r.y;return t.push(n,o),Kt.LINE_TO}},{key:"pathV",value:function(e,t){var r=zt.pathV(e).point,n=r.x,o=r.y;return t.push(n,o),Kt.LINE_TO}},{key:"pathC",value:function(e,t){var r=zt.pathC(e),n=r.point,o=r.controlPoint,s=r.currentPoint;t.push(n.x,n.y,o.x,o.y,s.x,s.y)}},{key:"pathS",value:function(e,t){var r=zt.pathS(e),n=r.point,o=r.controlPoint,s=r.currentPoint;return t.push(n.x,n.y,o.x,o.y,s.x,s.y),Kt.CURVE_TO}},{key:"pathQ",value:function(e,t){var r=zt.pathQ(e),n=r.controlPoint,o=r.currentPoint;t.push(n.x,n.y,o.x,o.y)}},{key:"pathT",value:function(e,t){var r=zt.pathT(e),n=r.controlPoint,o=r.currentPoint;return t.push(n.x,n.y,o.x,o.y),Kt.QUAD_TO}},{key:"pathA",value:function(e){var t=zt.pathA(e),r=t.rX,n=t.rY,o=t.sweepFlag,s=t.xAxisRotation,i=t.centp,a=t.a1,A=t.ad;return 0===o&&A>0&&(A-=2*Math.PI),1===o&&A<0&&(A+=2*Math.PI),[i.x,i.y,r,n,a,A,s,o]}},{key:"calcLength",value:function(e,t,r,n){var o=0,s=null,i=null,a=0;switch(r){case Kt.LINE_TO:return this.getLineLength(e,t,n[0],n[1]);case Kt.CURVE_TO:for(o=0,s=this.getPointOnCubicBezier(0,e,t,n[0],n[1],n[2],n[3],n[4],n[5]),a=.01;a<=1;a+=.01)i=this.getPointOnCubicBezier(a,e,t,n[0],n[1],n[2],n[3],n[4],n[5]),o+=this.getLineLength(s.x,s.y,i.x,i.y),s=i;return o;case Kt.QUAD_TO:for(o=0,s=this.getPointOnQuadraticBezier(0,e,t,n[0],n[1],n[2],n[3]),a=.01;a<=1;a+=.01)i=this.getPointOnQuadraticBezier(a,e,t,n[0],n[1],n[2],n[3]),o+=this.getLineLength(s.x,s.y,i.x,i.y),s=i;return o;case Kt.ARC:o=0;var A=n[4],u=n[5],c=n[4]+u,l=Math.PI/180;if(Math.abs(A-c)<l&&(l=Math.abs(A-c)),s=this.getPointOnEllipticalArc(n[0],n[1],n[2],n[3],A,0),u<0)for(a=A-l;a>c;a-=l)i=this.getPointOnEllipticalArc(n[0],n[1],n[2],n[3],a,0),o+=this.getLineLength(s.x,s.y,i.x,i.y),s=i;else for(a=A+l;a<c;a+=l)i=this.getPointOnEllipticalArc(n[0],n[1],n[2],n[3],a,0),o+=this.getLineLength(s.x,s.y,i.x,i.y),s=i;return i=this.getPointOnEllipticalArc(n[0],n[1],n[2],n[3],c,0),o+this.getLineLength(s.x,s.y,i.x,i.y)}return 0}},{key:"getPointOnLine",value:function(e,t,r,n,o){var s=arguments.length>5&&void 0!==arguments[5]?arguments[5]:t,i=arguments.length>6&&void 0!==arguments[6]?arguments[6]:r,a=(o-r)/(n-t+nt),A=Math.sqrt(e*e/(1+a*a));n<t&&(A*=-1);var u=a*A,c=null;if(n===t)c={x:s,y:i+u};else if((i-r)/(s-t+nt)===a)c={x:s+A,y:i+u};else{var l=0,d=0,f=this.getLineLength(t,r,n,o);if(f<nt)return null;var h=(s-t)*(n-t)+(i-r)*(o-r);l=t+(h/=f*f)*(n-t),d=r+h*(o-r);var p=this.getLineLength(s,i,l,d),m=Math.sqrt(e*e-p*p);A=Math.sqrt(m*m/(1+a*a)),n<t&&(A*=-1),c={x:l+A,y:d+(u=a*A)}}return c}},{key:"getPointOnPath",value:function(e){var t=this.getPathLength(),r=0,n=null;if(e<-5e-5||e-5e-5>t)return null;var o,s=function(e,t){var r;if(void 0===Fe()||null==Ne()(e)){if(xe()(e)||(r=function(e,t){var r;if(e){if("string"==typeof e)return mr(e,t);var n=Se()(r=Object.prototype.toString.call(e)).call(r,8,-1);return"Object"===n&&e.constructor&&(n=e.constructor.name),"Map"===n||"Set"===n?ae()(e):"Arguments"===n||/^(?:Ui|I)nt(?:8|16|32)(?:Clamped)?Array$/.test(n)?mr(e,t):void 0}}(e))||t&&e&&"number"==typeof e.length){r&&(e=r);var n=0,o=function(){};return{s:o,n:function(){return n>=e.length?{done:!0}:{done:!1,value:e[n++]}},e:function(e){throw e},f:o}}throw new TypeError("Invalid attempt to iterate non-iterable instance.\nIn order to be iterable, non-array objects must have a [Symbol.iterator]() method.")}var s,i=!0,a=!1;return{s:function(){r=_e()(e)},n:function(){var e=r.next();return i=e.done,e},e:function(e){a=!0,s=e},f:function(){try{i||null==r.return||r.return()}finally{if(a)throw s}}}}(this.dataArray);try{for(s.s();!(o=s.n()).done;){var i=o.value;if(!i||!(i.pathLength<5e-5||r+i.pathLength+5e-5<e)){var a=e-r,A=0;switch(i.type){case Kt.LINE_TO:n=this.getPointOnLine(a,i.start.x,i.start.y,i.points[0],i.points[1],i.start.x,i.start.y);break;case Kt.ARC:var u=i.points[4],c=i.points[5],l=i.points[4]+c;if(A=u+a/i.pathLength*c,c<0&&A<l||c>=0&&A>l)break;n=this.getPointOnEllipticalArc(i.points[0],i.points[1],i.points[2],i.points[3],A,i.points[6]);break;case Kt.CURVE_TO:(A=a/i.pathLength)>1&&(A=1),n=this.getPointOnCubicBezier(A,i.start.x,i.start.y,i.points[0],i.points[1],i.points[2],i.points[3],i.points[4],i.points[5]);break;case Kt.QUAD_TO:(A=a/i.pathLength)>1&&(A=1),n=this.getPointOnQuadraticBezier(A,i.start.x,i.start.y,i.points[0],i.points[1],i.points[2],i.points[3])}if(n)return n;break}r+=i.pathLength}}catch(e){s.e(e)}finally{s.f()}return null}},{key:"getLineLength",value:function(e,t,r,n){return Math.sqrt((r-e)*(r-e)+(n-t)*(n-t))}},{key:"getPathLength",value:function(){var e;return-1===this.pathLength&&(this.pathLength=H()(e=this.dataArray).call(e,(function(e,t){return t.pathLength>0?e+t.pathLength:e}),0)),this.pathLength}},{key:"getPointOnCubicBezier",value:function(e,t,r,n,o,s,i,a,A){return{x:a*at(e)+s*At(e)+n*ut(e)+t*ct(e),y:A*at(e)+i*At(e)+o*ut(e)+r*ct(e)}}},{key:"getPointOnQuadraticBezier",value:function(e,t,r,n,o,s,i){return{x:s*lt(e)+n*dt(e)+t*ft(e),y:i*lt(e)+o*dt(e)+r*ft(e)}}},{key:"getPointOnEllipticalArc",value:function(e,t,r,n,o,s){var i=Math.cos(s),a=Math.sin(s),A=r*Math.cos(o),u=n*Math.sin(o);return{x:e+(A*i-u*a),y:t+(A*a+u*i)}}},{key:"buildEquidistantCache",value:function(e,t){var r=this.getPathLength(),n=t||.25,o=e||r/100;if(!this.equidistantCache||this.equidistantCache.step!==o||this.equidistantCache.precision!==n){this.equidistantCache={step:o,precision:n,points:[]};for(var s=0,i=0;i<=r;i+=n){var a=this.getPointOnPath(i),A=this.getPointOnPath(i+n);a&&A&&(s+=this.getLineLength(a.x,a.y,A.x,A.y))>=o&&(this.equidistantCache.points.push({x:a.x,y:a.y,distance:i}),s-=o)}}}},{key:"getEquidistantPointOnPath",value:function(e,t,r){if(this.buildEquidistantCache(t,r),e<0||e-this.getPathLength()>5e-5)return null;var n=Math.round(e/this.getPathLength()*(this.equidistantCache.points.length-1));return this.equidistantCache.points[n]||null}}]),o}(Rt);var wr=function(e){(0,Z.default)(i,e);var t,r,n,o,s=(n=i,o=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,t=(0,ee.default)(n);if(o){var r=(0,ee.default)(this).constructor;e=Y()(t,arguments,r)}else e=t.apply(this,arguments);return(0,$.default)(this,e)});function i(e,t,r){var n;(0,F.default)(this,i),(n=s.call(this,e,t,r)).type="image",n.loaded=!1;var o=n.getHrefAttribute().getString();if(!o)return(0,$.default)(n);var a=/\.svg$/.test(o);return e.images.push((0,ye.default)(n)),a?n.loadSvg(o):n.loadImage(o),n.isSvg=a,n}return(0,U.default)(i,[{key:"loadImage",value:(r=(0,N.default)(E().mark((function e(t){var r;return E().wrap((function(e){for(;;)switch(e.prev=e.next){case 0:return e.prev=0,e.next=3,this.document.createImage(t);case 3:r=e.sent,this.image=r,e.next=10;break;case 7:e.prev=7,e.t0=e.catch(0),console.error('Error while loading image "'.concat(t,'":'),e.t0);case 10:this.loaded=!0;case 11:case"end":return e.stop()}}),e,this,[[0,7]])}))),function(e){return r.apply(this,arguments)})},{key:"loadSvg",value:(t=(0,N.default)(E().mark((function e(t){var r,n;return E().wrap((function(e){for(;;)switch(e.prev=e.next){case 0:return e.prev=0,e.next=3,this.document.fetch(t);case 3:return r=e.sent,e.next=6,r.text();case 6:n=e.sent,this.image=n,e.next=13;break;case 10:e.prev=10,e.t0=e.catch(0),console.error('Error while loading image "'.concat(t,'":'),e.t0);case 13:this.loaded=!0;case 14:case"end":return e.stop()}}),e,this,[[0,10]])}))),function(e){return t.apply(this,arguments)})},{key:"renderChildren",value:function(e){var t=this.document,r=this.image,n=this.loaded,o=this.getAttribute("x").getPixels("x"),s=this.getAttribute("y").getPixels("y"),i=this.getStyle("width").getPixels("x"),a=this.getStyle("height").getPixels("y");if(n&&r&&i&&a){if(e.save(),this.isSvg)t.canvg.forkString(e,this.image,{ignoreMouse:!0,ignoreAnimation:!0,ignoreDimensions:!0,ignoreClear:!0,offsetX:o,offsetY:s,scaleWidth:i,scaleHeight:a}).render();else{var A=this.image;e.translate(o,s),t.setViewBox({ctx:e,aspectRatio:this.getAttribute("preserveAspectRatio").getString(),width:i,desiredWidth:A.width,height:a,desiredHeight:A.height}),this.loaded&&(void 0===A.complete||A.complete)&&e.drawImage(A,0,0)}e.restore()}}},{key:"getBoundingBox",value:function(){var e=this.getAttribute("x").getPixels("x"),t=this.getAttribute("y").getPixels("y"),r=this.getStyle("width").getPixels("x"),n=this.getStyle("height").getPixels("y");return new Ot(e,t,e+r,t+n)}}]),i}(kt);var br=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="symbol",e}return(0,U.default)(o,[{key:"render",value:function(e){}}]),o}(kt),Br=function(){function e(t){(0,F.default)(this,e),this.document=t,this.loaded=!1,t.fonts.push(this)}var t;return(0,U.default)(e,[{key:"load",value:(t=(0,N.default)(E().mark((function e(t,r){var n,o,s,i;return E().wrap((function(e){for(;;)switch(e.prev=e.next){case 0:return e.prev=0,o=this.document,e.next=4,o.canvg.parser.load(r);case 4:s=e.sent,i=s.getElementsByTagName("font"),g()(n=ae()(i)).call(n,(function(e){var r=o.createElement(e);o.definitions[t]=r})),e.next=12;break;case 9:e.prev=9,e.t0=e.catch(0),console.error('Error while loading font "'.concat(r,'":'),e.t0);case 12:this.loaded=!0;case 13:case"end":return e.stop()}}),e,this,[[0,9]])}))),function(e,r){return t.apply(this,arguments)})}]),e}();var jr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s,i;(0,F.default)(this,o),(i=n.call(this,e,t,r)).type="style";var a=Re(A()(s=ae()(t.childNodes)).call(s,(function(e){return e.data})).join("").replace(/(\/\*([^*]|[\r\n]|(\*+([^*\/]|[\r\n])))*\*+\/)|(^[\s]*\/\/.*)/gm,"").replace(/@import.*;/g,"")).split("}");return g()(a).call(a,(function(t){var r=G()(t).call(t);if(r){var n=r.split("{"),o=n[0].split(","),s=n[1].split(";");g()(o).call(o,(function(t){var r=G()(t).call(t);if(r){var n=e.styles[r]||{};if(g()(s).call(s,(function(t){var r,o,s=le()(t).call(t,":"),i=G()(r=t.substr(0,s)).call(r),a=G()(o=t.substr(s+1,t.length-s)).call(o);i&&a&&(n[i]=new ht(e,i,a))})),e.styles[r]=n,e.stylesSpecificity[r]=rt(r),"@font-face"===r){var o=n["font-family"].getString().replace(/"|'/g,""),i=n.src.getString().split(",");g()(i).call(i,(function(t){if(le()(t).call(t,'format("svg")')>0){var r=qe(t);r&&new Br(e).load(o,r)}}))}}}))}})),i}return o}(St);jr.parseExternalUrl=qe;var _r=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="use",e}return(0,U.default)(o,[{key:"setContext",value:function(e){(0,de.default)((0,ee.default)(o.prototype),"setContext",this).call(this,e);var t=this.getAttribute("x"),r=this.getAttribute("y");t.hasValue()&&e.translate(t.getPixels("x"),0),r.hasValue()&&e.translate(0,r.getPixels("y"))}},{key:"path",value:function(e){var t=this.element;t&&t.path(e)}},{key:"renderChildren",value:function(e){var t=this.document,r=this.element;if(r){var n=r;if("symbol"===r.type&&((n=new Vt(t,null)).attributes.viewBox=new ht(t,"viewBox",r.getAttribute("viewBox").getString()),n.attributes.preserveAspectRatio=new ht(t,"preserveAspectRatio",r.getAttribute("preserveAspectRatio").getString()),n.attributes.overflow=new ht(t,"overflow",r.getAttribute("overflow").getString()),n.children=r.children,r.styles.opacity=new ht(t,"opacity",this.calculateOpacity())),"svg"===n.type){var o=this.getStyle("width",!1,!0),s=this.getStyle("height",!1,!0);o.hasValue()&&(n.attributes.width=new ht(t,"width",o.getString())),s.hasValue()&&(n.attributes.height=new ht(t,"height",s.getString()))}var i=n.parent;n.parent=this,n.render(e),n.parent=i}}},{key:"getBoundingBox",value:function(e){var t=this.element;return t?t.getBoundingBox(e):null}},{key:"elementTransform",value:function(){var e=this.document,t=this.element;return Ut.fromElement(e,t)}},{key:"element",get:function(){return this._element||(this._element=this.getHrefAttribute().getDefinition()),this._element}}]),o}(kt);function Cr(e,t,r,n,o,s){return e[r*n*4+4*t+s]}function xr(e,t,r,n,o,s,i){e[r*n*4+4*t+s]=i}function Er(e,t,r){return e[t]*r}function Nr(e,t,r,n){return t+Math.cos(e)*r+Math.sin(e)*n}var Qr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s;(0,F.default)(this,o),(s=n.call(this,e,t,r)).type="feColorMatrix";var i=Ke(s.getAttribute("values").getString());switch(s.getAttribute("type").getString("matrix")){case"saturate":var a=i[0];i=[.213+.787*a,.715-.715*a,.072-.072*a,0,0,.213-.213*a,.715+.285*a,.072-.072*a,0,0,.213-.213*a,.715-.715*a,.072+.928*a,0,0,0,0,0,1,0,0,0,0,0,1];break;case"hueRotate":var A=i[0]*Math.PI/180;i=[Nr(A,.213,.787,-.213),Nr(A,.715,-.715,-.715),Nr(A,.072,-.072,.928),0,0,Nr(A,.213,-.213,.143),Nr(A,.715,.285,.14),Nr(A,.072,-.072,-.283),0,0,Nr(A,.213,-.213,-.787),Nr(A,.715,-.715,.715),Nr(A,.072,.928,.072),0,0,0,0,0,1,0,0,0,0,0,1];break;case"luminanceToAlpha":i=[0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,.2125,.7154,.0721,0,0,0,0,0,0,1]}return s.matrix=i,s.includeOpacity=s.getAttribute("includeOpacity").hasValue(),s}return(0,U.default)(o,[{key:"apply",value:function(e,t,r,n,o){for(var s=this.includeOpacity,i=this.matrix,a=e.getImageData(0,0,n,o),A=0;A<o;A++)for(var u=0;u<n;u++){var c=Cr(a.data,u,A,n,0,0),l=Cr(a.data,u,A,n,0,1),d=Cr(a.data,u,A,n,0,2),f=Cr(a.data,u,A,n,0,3),h=Er(i,0,c)+Er(i,1,l)+Er(i,2,d)+Er(i,3,f)+Er(i,4,1),p=Er(i,5,c)+Er(i,6,l)+Er(i,7,d)+Er(i,8,f)+Er(i,9,1),m=Er(i,10,c)+Er(i,11,l)+Er(i,12,d)+Er(i,13,f)+Er(i,14,1),g=Er(i,15,c)+Er(i,16,l)+Er(i,17,d)+Er(i,18,f)+Er(i,19,1);s&&(h=p=m=0,g*=f/255),xr(a.data,u,A,n,0,0,h),xr(a.data,u,A,n,0,1,p),xr(a.data,u,A,n,0,2,m),xr(a.data,u,A,n,0,3,g)}e.clearRect(0,0,n,o),e.putImageData(a,0,0)}}]),o}(St);var Fr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="mask",e}return(0,U.default)(o,[{key:"apply",value:function(e,t){var r=this.document,n=this.getAttribute("x").getPixels("x"),s=this.getAttribute("y").getPixels("y"),i=this.getStyle("width").getPixels("x"),a=this.getStyle("height").getPixels("y");if(!i&&!a){var A,u=new Ot;g()(A=this.children).call(A,(function(t){u.addBoundingBox(t.getBoundingBox(e))})),n=Math.floor(u.x1),s=Math.floor(u.y1),i=Math.floor(u.width),a=Math.floor(u.height)}var c=this.removeStyles(t,o.ignoreStyles),l=r.createCanvas(n+i,s+a),d=l.getContext("2d");r.screen.setDefaults(d),this.renderChildren(d),new Qr(r,{nodeType:1,childNodes:[],attributes:[{nodeName:"type",value:"luminanceToAlpha"},{nodeName:"includeOpacity",value:"true"}]}).apply(d,0,0,n+i,s+a);var f=r.createCanvas(n+i,s+a),h=f.getContext("2d");r.screen.setDefaults(h),t.render(h),h.globalCompositeOperation="destination-in",h.fillStyle=d.createPattern(l,"no-repeat"),h.fillRect(0,0,n+i,s+a),e.fillStyle=h.createPattern(f,"no-repeat"),e.fillRect(0,0,n+i,s+a),this.restoreStyles(t,c)}},{key:"render",value:function(e){}}]),o}(St);Fr.ignoreStyles=["mask","transform","clip-path"];var Ur=function(){},Sr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="clipPath",e}return(0,U.default)(o,[{key:"apply",value:function(e){var t,r=this.document,n=Oe()(e),o=e.beginPath,s=e.closePath;n&&(n.beginPath=Ur,n.closePath=Ur),Ie()(o,e,[]),g()(t=this.children).call(t,(function(t){if(void 0!==t.path){var o=void 0!==t.elementTransform?t.elementTransform():null;o||(o=Ut.fromElement(r,t)),o&&o.apply(e),t.path(e),n&&(n.closePath=s),o&&o.unapply(e)}})),Ie()(s,e,[]),e.clip(),n&&(n.beginPath=o,n.closePath=s)}},{key:"render",value:function(e){}}]),o}(St);var Lr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="filter",e}return(0,U.default)(o,[{key:"apply",value:function(e,t){var r=this.document,n=this.children,s=t.getBoundingBox(e);if(s){var i=0,a=0;g()(n).call(n,(function(e){var t=e.extraFilterDistance||0;i=Math.max(i,t),a=Math.max(a,t)}));var A=Math.floor(s.width),u=Math.floor(s.height),c=A+2*i,l=u+2*a;if(!(c<1||l<1)){var d=Math.floor(s.x),f=Math.floor(s.y),h=this.removeStyles(t,o.ignoreStyles),p=r.createCanvas(c,l),m=p.getContext("2d");r.screen.setDefaults(m),m.translate(-d+i,-f+a),t.render(m),g()(n).call(n,(function(e){"function"==typeof e.apply&&e.apply(m,0,0,c,l)})),e.drawImage(p,0,0,c,l,d-i,f-a,c,l),this.restoreStyles(t,h)}}}},{key:"render",value:function(e){}}]),o}(St);Lr.ignoreStyles=["filter","transform","clip-path"];var Tr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s;return(0,F.default)(this,o),(s=n.call(this,e,t,r)).type="feDropShadow",s.addStylesFromStyleDefinition(),s}return(0,U.default)(o,[{key:"apply",value:function(e,t,r,n,o){}}]),o}(St);var Hr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="feMorphology",e}return(0,U.default)(o,[{key:"apply",value:function(e,t,r,n,o){}}]),o}(St);var Ir=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="feComposite",e}return(0,U.default)(o,[{key:"apply",value:function(e,t,r,n,o){}}]),o}(St);var Pr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(e,t,r){var s;return(0,F.default)(this,o),(s=n.call(this,e,t,r)).type="feGaussianBlur",s.blurRadius=Math.floor(s.getAttribute("stdDeviation").getNumber()),s.extraFilterDistance=s.blurRadius,s}return(0,U.default)(o,[{key:"apply",value:function(e,t,r,n,o){var s=this.document,i=this.blurRadius,a=s.window?s.window.document.body:null,A=e.canvas;A.id=s.getUniqueId(),a&&(A.style.display="none",a.appendChild(A)),(0,ke.canvasRGBA)(A,t,r,n,o,i),a&&a.removeChild(A)}}]),o}(St);var Or=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="title",e}return o}(St);var kr=function(e){(0,Z.default)(o,e);var t,r,n=(t=o,r=function(){if("undefined"==typeof Reflect||!Y())return!1;if(Y().sham)return!1;if("function"==typeof Proxy)return!0;try{return Date.prototype.toString.call(Y()(Date,[],(function(){}))),!0}catch(e){return!1}}(),function(){var e,n=(0,ee.default)(t);if(r){var o=(0,ee.default)(this).constructor;e=Y()(n,arguments,o)}else e=n.apply(this,arguments);return(0,$.default)(this,e)});function o(){var e;return(0,F.default)(this,o),(e=n.apply(this,arguments)).type="desc",e}return o}(St),Rr={svg:Vt,rect:qt,circle:Gt,ellipse:Xt,line:Wt,polyline:Jt,polygon:Yt,path:zt,pattern:Zt,marker:$t,defs:er,linearGradient:nr,radialGradient:or,stop:sr,animate:ir,animateColor:ar,animateTransform:Ar,font:cr,"font-face":lr,"missing-glyph":dr,glyph:fr,text:Rt,tspan:Mt,tref:hr,a:pr,textPath:vr,image:wr,g:tr,symbol:br,style:jr,use:_r,mask:Fr,clipPath:Sr,filter:Lr,feDropShadow:Tr,feMorphology:Hr,feComposite:Ir,feColorMatrix:Qr,feGaussianBlur:Pr,title:Or,desc:kr};function Mr(e,t){var r=C()(e);if(j()){var n=j()(e);t&&(n=b()(n).call(n,(function(t){return v()(e,t).enumerable}))),r.push.apply(r,n)}return r}function Dr(){return(Dr=(0,N.default)(E().mark((function e(t){var r,n,o=arguments;return E().wrap((function(e){for(;;)switch(e.prev=e.next){case 0:return r=o.length>1&&void 0!==o[1]&&o[1],n=document.createElement("img"),r&&(n.crossOrigin="Anonymous"),e.abrupt("return",new(M())((function(e,r){n.onload=function(){e(n)},n.onerror=function(){r()},n.src=t})));case 4:case"end":return e.stop()}}),e)})))).apply(this,arguments)}var Kr=function(){function e(t){var r,n,o=arguments.length>1&&void 0!==arguments[1]?arguments[1]:{},s=o.rootEmSize,i=void 0===s?12:s,a=o.emSize,A=void 0===a?12:a,u=o.createCanvas,c=void 0===u?e.createCanvas:u,l=o.createImage,d=void 0===l?e.createImage:l,f=o.anonymousCrossOrigin;(0,F.default)(this,e),this.canvg=t,this.definitions={},this.styles={},this.stylesSpecificity={},this.images=[],this.fonts=[],this.emSizeStack=[],this.uniqueId=0,this.screen=t.screen,this.rootEmSize=i,this.emSize=A,this.createCanvas=c,this.createImage=this.bindCreateImage(d,f),this.screen.wait(K()(r=this.isImagesLoaded).call(r,this)),this.screen.wait(K()(n=this.isFontsLoaded).call(n,this))}return(0,U.default)(e,[{key:"bindCreateImage",value:function(e,t){return"boolean"==typeof t?function(r,n){return e(r,"boolean"==typeof n?n:t)}:e}},{key:"popEmSize",value:function(){this.emSizeStack.pop()}},{key:"getUniqueId",value:function(){return"canvg".concat(++this.uniqueId)}},{key:"isImagesLoaded",value:function(){var e;return k()(e=this.images).call(e,(function(e){return e.loaded}))}},{key:"isFontsLoaded",value:function(){var e;return k()(e=this.fonts).call(e,(function(e){return e.loaded}))}},{key:"createDocumentElement",value:function(e){var t=this.createElement(e.documentElement);return t.root=!0,t.addStylesFromStyleDefinition(),this.documentElement=t,t}},{key:"createElement",value:function(t){var r=t.nodeName.replace(/^[^:]+:/,""),n=e.elementTypes[r];return void 0!==n?new n(this,t):new Lt(this,t)}},{key:"createTextNode",value:function(e){return new Dt(this,e)}},{key:"setViewBox",value:function(e){this.screen.setViewBox(function(e){for(var t=1;t<arguments.length;t++){var r,n=null!=arguments[t]?arguments[t]:{};if(t%2)g()(r=Mr(Object(n),!0)).call(r,(function(t){(0,Q.default)(e,t,n[t])}));else if(p())f()(e,p()(n));else{var o;g()(o=Mr(Object(n))).call(o,(function(t){l()(e,t,v()(n,t))}))}}return e}({document:this},e))}},{key:"window",get:function(){return this.screen.window}},{key:"fetch",get:function(){return this.screen.fetch}},{key:"ctx",get:function(){return this.screen.ctx}},{key:"emSize",get:function(){var e=this.emSizeStack;return e[e.length-1]},set:function(e){this.emSizeStack.push(e)}}]),e}();function zr(e,t){var r=C()(e);if(j()){var n=j()(e);t&&(n=b()(n).call(n,(function(t){return v()(e,t).enumerable}))),r.push.apply(r,n)}return r}function Vr(e){for(var t=1;t<arguments.length;t++){var r,n=null!=arguments[t]?arguments[t]:{};if(t%2)g()(r=zr(Object(n),!0)).call(r,(function(t){(0,Q.default)(e,t,n[t])}));else if(p())f()(e,p()(n));else{var o;g()(o=zr(Object(n))).call(o,(function(t){l()(e,t,v()(n,t))}))}}return e}Kr.createCanvas=function(e,t){var r=document.createElement("canvas");return r.width=e,r.height=t,r},Kr.createImage=function(e){return Dr.apply(this,arguments)},Kr.elementTypes=Rr;var qr=function(){function e(t,r){var n=arguments.length>2&&void 0!==arguments[2]?arguments[2]:{};(0,F.default)(this,e),this.parser=new jt(n),this.screen=new wt(t,n),this.options=n;var o=new Kr(this,n),s=o.createDocumentElement(r);this.document=o,this.documentElement=s}var t,r;return(0,U.default)(e,[{key:"fork",value:function(t,r){var n=arguments.length>2&&void 0!==arguments[2]?arguments[2]:{};return e.from(t,r,Vr(Vr({},this.options),n))}},{key:"forkString",value:function(t,r){var n=arguments.length>2&&void 0!==arguments[2]?arguments[2]:{};return e.fromString(t,r,Vr(Vr({},this.options),n))}},{key:"ready",value:function(){return this.screen.ready()}},{key:"isReady",value:function(){return this.screen.isReady()}},{key:"render",value:(r=(0,N.default)(E().mark((function e(){var t,r=arguments;return E().wrap((function(e){for(;;)switch(e.prev=e.next){case 0:return t=r.length>0&&void 0!==r[0]?r[0]:{},this.start(Vr({enableRedraw:!0,ignoreAnimation:!0,ignoreMouse:!0},t)),e.next=4,this.ready();case 4:this.stop();case 5:case"end":return e.stop()}}),e,this)}))),function(){return r.apply(this,arguments)})},{key:"start",value:function(){var e=arguments.length>0&&void 0!==arguments[0]?arguments[0]:{},t=this.documentElement,r=this.screen,n=this.options;r.start(t,Vr(Vr({enableRedraw:!0},n),e))}},{key:"stop",value:function(){this.screen.stop()}},{key:"resize",value:function(e){var t=arguments.length>1&&void 0!==arguments[1]?arguments[1]:e,r=arguments.length>2&&void 0!==arguments[2]&&arguments[2];this.documentElement.resize(e,t,r)}}],[{key:"from",value:(t=(0,N.default)(E().mark((function t(r,n){var o,s,i,a=arguments;return E().wrap((function(t){for(;;)switch(t.prev=t.next){case 0:return o=a.length>2&&void 0!==a[2]?a[2]:{},s=new jt(o),t.next=4,s.parse(n);case 4:return i=t.sent,t.abrupt("return",new e(r,i,o));case 6:case"end":return t.stop()}}),t)}))),function(e,r){return t.apply(this,arguments)})},{key:"fromString",value:function(t,r){var n=arguments.length>2&&void 0!==arguments[2]?arguments[2]:{},o=new jt(n),s=o.parseFromString(r);return new e(t,s,n)}}]),e}(),Gr=Object.freeze({__proto__:null,offscreen:function(){var e=arguments.length>0&&void 0!==arguments[0]?arguments[0]:{},t=e.DOMParser,r={window:null,ignoreAnimation:!0,ignoreMouse:!0,DOMParser:t,createCanvas:function(e,t){return new OffscreenCanvas(e,t)},createImage:function(e){return(0,N.default)(E().mark((function t(){var r,n,o;return E().wrap((function(t){for(;;)switch(t.prev=t.next){case 0:return t.next=2,fetch(e);case 2:return r=t.sent,t.next=5,r.blob();case 5:return n=t.sent,t.next=8,createImageBitmap(n);case 8:return o=t.sent,t.abrupt("return",o);case 10:case"end":return t.stop()}}),t)})))()}};return"undefined"==typeof DOMParser&&void 0!==t||ge()(r,"DOMParser"),r},node:function(e){var t=e.DOMParser,r=e.canvas;return{window:null,ignoreAnimation:!0,ignoreMouse:!0,DOMParser:t,fetch:e.fetch,createCanvas:r.createCanvas,createImage:r.loadImage}}});t.default=qr},"./node_modules/core-js-pure/es/array/from.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.string.iterator.js"),r("./node_modules/core-js-pure/modules/es.array.from.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.Array.from},"./node_modules/core-js-pure/es/array/is-array.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.array.is-array.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.Array.isArray},"./node_modules/core-js-pure/es/array/virtual/concat.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.array.concat.js");var n=r("./node_modules/core-js-pure/internals/entry-virtual.js");e.exports=n("Array").concat},"./node_modules/core-js-pure/es/array/virtual/every.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.array.every.js");var n=r("./node_modules/core-js-pure/internals/entry-virtual.js");e.exports=n("Array").every},"./node_modules/core-js-pure/es/array/virtual/fill.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.array.fill.js");var n=r("./node_modules/core-js-pure/internals/entry-virtual.js");e.exports=n("Array").fill},"./node_modules/core-js-pure/es/array/virtual/filter.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.array.filter.js");var n=r("./node_modules/core-js-pure/internals/entry-virtual.js");e.exports=n("Array").filter},"./node_modules/core-js-pure/es/array/virtual/for-each.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.array.for-each.js");var n=r("./node_modules/core-js-pure/internals/entry-virtual.js");e.exports=n("Array").forEach},"./node_modules/core-js-pure/es/array/virtual/includes.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.array.includes.js");var n=r("./node_modules/core-js-pure/internals/entry-virtual.js");e.exports=n("Array").includes},"./node_modules/core-js-pure/es/array/virtual/index-of.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.array.index-of.js");var n=r("./node_modules/core-js-pure/internals/entry-virtual.js");e.exports=n("Array").indexOf},"./node_modules/core-js-pure/es/array/virtual/map.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.array.map.js");var n=r("./node_modules/core-js-pure/internals/entry-virtual.js");e.exports=n("Array").map},"./node_modules/core-js-pure/es/array/virtual/reduce.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.array.reduce.js");var n=r("./node_modules/core-js-pure/internals/entry-virtual.js");e.exports=n("Array").reduce},"./node_modules/core-js-pure/es/array/virtual/reverse.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.array.reverse.js");var n=r("./node_modules/core-js-pure/internals/entry-virtual.js");e.exports=n("Array").reverse},"./node_modules/core-js-pure/es/array/virtual/slice.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.array.slice.js");var n=r("./node_modules/core-js-pure/internals/entry-virtual.js");e.exports=n("Array").slice},"./node_modules/core-js-pure/es/array/virtual/some.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.array.some.js");var n=r("./node_modules/core-js-pure/internals/entry-virtual.js");e.exports=n("Array").some},"./node_modules/core-js-pure/es/array/virtual/values.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.array.iterator.js");var n=r("./node_modules/core-js-pure/internals/entry-virtual.js");e.exports=n("Array").values},"./node_modules/core-js-pure/es/date/now.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.date.now.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.Date.now},"./node_modules/core-js-pure/es/function/virtual/bind.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.function.bind.js");var n=r("./node_modules/core-js-pure/internals/entry-virtual.js");e.exports=n("Function").bind},"./node_modules/core-js-pure/es/instance/bind.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/function/virtual/bind.js"),o=Function.prototype;e.exports=function(e){var t=e.bind;return e===o||e instanceof Function&&t===o.bind?n:t}},"./node_modules/core-js-pure/es/instance/concat.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/array/virtual/concat.js"),o=Array.prototype;e.exports=function(e){var t=e.concat;return e===o||e instanceof Array&&t===o.concat?n:t}},"./node_modules/core-js-pure/es/instance/every.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/array/virtual/every.js"),o=Array.prototype;e.exports=function(e){var t=e.every;return e===o||e instanceof Array&&t===o.every?n:t}},"./node_modules/core-js-pure/es/instance/fill.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/array/virtual/fill.js"),o=Array.prototype;e.exports=function(e){var t=e.fill;return e===o||e instanceof Array&&t===o.fill?n:t}},"./node_modules/core-js-pure/es/instance/filter.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/array/virtual/filter.js"),o=Array.prototype;e.exports=function(e){var t=e.filter;return e===o||e instanceof Array&&t===o.filter?n:t}},"./node_modules/core-js-pure/es/instance/includes.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/array/virtual/includes.js"),o=r("./node_modules/core-js-pure/es/string/virtual/includes.js"),s=Array.prototype,i=String.prototype;e.exports=function(e){var t=e.includes;return e===s||e instanceof Array&&t===s.includes?n:"string"==typeof e||e===i||e instanceof String&&t===i.includes?o:t}},"./node_modules/core-js-pure/es/instance/index-of.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/array/virtual/index-of.js"),o=Array.prototype;e.exports=function(e){var t=e.indexOf;return e===o||e instanceof Array&&t===o.indexOf?n:t}},"./node_modules/core-js-pure/es/instance/map.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/array/virtual/map.js"),o=Array.prototype;e.exports=function(e){var t=e.map;return e===o||e instanceof Array&&t===o.map?n:t}},"./node_modules/core-js-pure/es/instance/reduce.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/array/virtual/reduce.js"),o=Array.prototype;e.exports=function(e){var t=e.reduce;return e===o||e instanceof Array&&t===o.reduce?n:t}},"./node_modules/core-js-pure/es/instance/reverse.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/array/virtual/reverse.js"),o=Array.prototype;e.exports=function(e){var t=e.reverse;return e===o||e instanceof Array&&t===o.reverse?n:t}},"./node_modules/core-js-pure/es/instance/slice.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/array/virtual/slice.js"),o=Array.prototype;e.exports=function(e){var t=e.slice;return e===o||e instanceof Array&&t===o.slice?n:t}},"./node_modules/core-js-pure/es/instance/some.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/array/virtual/some.js"),o=Array.prototype;e.exports=function(e){var t=e.some;return e===o||e instanceof Array&&t===o.some?n:t}},"./node_modules/core-js-pure/es/instance/starts-with.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/string/virtual/starts-with.js"),o=String.prototype;e.exports=function(e){var t=e.startsWith;return"string"==typeof e||e===o||e instanceof String&&t===o.startsWith?n:t}},"./node_modules/core-js-pure/es/instance/trim.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/string/virtual/trim.js"),o=String.prototype;e.exports=function(e){var t=e.trim;return"string"==typeof e||e===o||e instanceof String&&t===o.trim?n:t}},"./node_modules/core-js-pure/es/map/index.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.map.js"),r("./node_modules/core-js-pure/modules/es.object.to-string.js"),r("./node_modules/core-js-pure/modules/es.string.iterator.js"),r("./node_modules/core-js-pure/modules/web.dom-collections.iterator.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.Map},"./node_modules/core-js-pure/es/object/create.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.object.create.js");var n=r("./node_modules/core-js-pure/internals/path.js").Object;e.exports=function(e,t){return n.create(e,t)}},"./node_modules/core-js-pure/es/object/define-properties.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.object.define-properties.js");var n=r("./node_modules/core-js-pure/internals/path.js").Object,o=e.exports=function(e,t){return n.defineProperties(e,t)};n.defineProperties.sham&&(o.sham=!0)},"./node_modules/core-js-pure/es/object/define-property.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.object.define-property.js");var n=r("./node_modules/core-js-pure/internals/path.js").Object,o=e.exports=function(e,t,r){return n.defineProperty(e,t,r)};n.defineProperty.sham&&(o.sham=!0)},"./node_modules/core-js-pure/es/object/get-own-property-descriptor.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.object.get-own-property-descriptor.js");var n=r("./node_modules/core-js-pure/internals/path.js").Object,o=e.exports=function(e,t){return n.getOwnPropertyDescriptor(e,t)};n.getOwnPropertyDescriptor.sham&&(o.sham=!0)},"./node_modules/core-js-pure/es/object/get-own-property-descriptors.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.object.get-own-property-descriptors.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.Object.getOwnPropertyDescriptors},"./node_modules/core-js-pure/es/object/get-own-property-symbols.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.symbol.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.Object.getOwnPropertySymbols},"./node_modules/core-js-pure/es/object/get-prototype-of.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.object.get-prototype-of.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.Object.getPrototypeOf},"./node_modules/core-js-pure/es/object/keys.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.object.keys.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.Object.keys},"./node_modules/core-js-pure/es/object/set-prototype-of.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.object.set-prototype-of.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.Object.setPrototypeOf},"./node_modules/core-js-pure/es/parse-float.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.parse-float.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.parseFloat},"./node_modules/core-js-pure/es/parse-int.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.parse-int.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.parseInt},"./node_modules/core-js-pure/es/promise/index.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.aggregate-error.js"),r("./node_modules/core-js-pure/modules/es.object.to-string.js"),r("./node_modules/core-js-pure/modules/es.promise.js"),r("./node_modules/core-js-pure/modules/es.promise.all-settled.js"),r("./node_modules/core-js-pure/modules/es.promise.any.js"),r("./node_modules/core-js-pure/modules/es.promise.finally.js"),r("./node_modules/core-js-pure/modules/es.string.iterator.js"),r("./node_modules/core-js-pure/modules/web.dom-collections.iterator.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.Promise},"./node_modules/core-js-pure/es/reflect/apply.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.reflect.apply.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.Reflect.apply},"./node_modules/core-js-pure/es/reflect/construct.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.reflect.construct.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.Reflect.construct},"./node_modules/core-js-pure/es/reflect/delete-property.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.reflect.delete-property.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.Reflect.deleteProperty},"./node_modules/core-js-pure/es/reflect/get-prototype-of.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.reflect.get-prototype-of.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.Reflect.getPrototypeOf},"./node_modules/core-js-pure/es/reflect/get.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.reflect.get.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.Reflect.get},"./node_modules/core-js-pure/es/string/virtual/includes.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.string.includes.js");var n=r("./node_modules/core-js-pure/internals/entry-virtual.js");e.exports=n("String").includes},"./node_modules/core-js-pure/es/string/virtual/starts-with.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.string.starts-with.js");var n=r("./node_modules/core-js-pure/internals/entry-virtual.js");e.exports=n("String").startsWith},"./node_modules/core-js-pure/es/string/virtual/trim.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.string.trim.js");var n=r("./node_modules/core-js-pure/internals/entry-virtual.js");e.exports=n("String").trim},"./node_modules/core-js-pure/es/symbol/index.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.array.concat.js"),r("./node_modules/core-js-pure/modules/es.object.to-string.js"),r("./node_modules/core-js-pure/modules/es.symbol.js"),r("./node_modules/core-js-pure/modules/es.symbol.async-iterator.js"),r("./node_modules/core-js-pure/modules/es.symbol.description.js"),r("./node_modules/core-js-pure/modules/es.symbol.has-instance.js"),r("./node_modules/core-js-pure/modules/es.symbol.is-concat-spreadable.js"),r("./node_modules/core-js-pure/modules/es.symbol.iterator.js"),r("./node_modules/core-js-pure/modules/es.symbol.match.js"),r("./node_modules/core-js-pure/modules/es.symbol.match-all.js"),r("./node_modules/core-js-pure/modules/es.symbol.replace.js"),r("./node_modules/core-js-pure/modules/es.symbol.search.js"),r("./node_modules/core-js-pure/modules/es.symbol.species.js"),r("./node_modules/core-js-pure/modules/es.symbol.split.js"),r("./node_modules/core-js-pure/modules/es.symbol.to-primitive.js"),r("./node_modules/core-js-pure/modules/es.symbol.to-string-tag.js"),r("./node_modules/core-js-pure/modules/es.symbol.unscopables.js"),r("./node_modules/core-js-pure/modules/es.json.to-string-tag.js"),r("./node_modules/core-js-pure/modules/es.math.to-string-tag.js"),r("./node_modules/core-js-pure/modules/es.reflect.to-string-tag.js");var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=n.Symbol},"./node_modules/core-js-pure/es/symbol/iterator.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.symbol.iterator.js"),r("./node_modules/core-js-pure/modules/es.string.iterator.js"),r("./node_modules/core-js-pure/modules/web.dom-collections.iterator.js");var n=r("./node_modules/core-js-pure/internals/well-known-symbol-wrapped.js");e.exports=n.f("iterator")},"./node_modules/core-js-pure/features/array/from.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/array/from.js");e.exports=n},"./node_modules/core-js-pure/features/array/is-array.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/array/is-array.js");e.exports=n},"./node_modules/core-js-pure/features/get-iterator-method.js":function(e,t,r){r("./node_modules/core-js-pure/modules/web.dom-collections.iterator.js"),r("./node_modules/core-js-pure/modules/es.string.iterator.js");var n=r("./node_modules/core-js-pure/internals/get-iterator-method.js");e.exports=n},"./node_modules/core-js-pure/features/get-iterator.js":function(e,t,r){r("./node_modules/core-js-pure/modules/web.dom-collections.iterator.js"),r("./node_modules/core-js-pure/modules/es.string.iterator.js");var n=r("./node_modules/core-js-pure/internals/get-iterator.js");e.exports=n},"./node_modules/core-js-pure/features/instance/slice.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/instance/slice.js");e.exports=n},"./node_modules/core-js-pure/features/object/create.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/object/create.js");e.exports=n},"./node_modules/core-js-pure/features/object/define-property.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/object/define-property.js");e.exports=n},"./node_modules/core-js-pure/features/object/get-own-property-descriptor.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/object/get-own-property-descriptor.js");e.exports=n},"./node_modules/core-js-pure/features/object/get-prototype-of.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/object/get-prototype-of.js");e.exports=n},"./node_modules/core-js-pure/features/object/set-prototype-of.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/object/set-prototype-of.js");e.exports=n},"./node_modules/core-js-pure/features/promise/index.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/promise/index.js");r("./node_modules/core-js-pure/modules/esnext.aggregate-error.js"),r("./node_modules/core-js-pure/modules/esnext.promise.all-settled.js"),r("./node_modules/core-js-pure/modules/esnext.promise.try.js"),r("./node_modules/core-js-pure/modules/esnext.promise.any.js"),e.exports=n},"./node_modules/core-js-pure/features/reflect/get.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/reflect/get.js");e.exports=n},"./node_modules/core-js-pure/features/symbol/index.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/symbol/index.js");r("./node_modules/core-js-pure/modules/esnext.symbol.async-dispose.js"),r("./node_modules/core-js-pure/modules/esnext.symbol.dispose.js"),r("./node_modules/core-js-pure/modules/esnext.symbol.matcher.js"),r("./node_modules/core-js-pure/modules/esnext.symbol.metadata.js"),r("./node_modules/core-js-pure/modules/esnext.symbol.observable.js"),r("./node_modules/core-js-pure/modules/esnext.symbol.pattern-match.js"),r("./node_modules/core-js-pure/modules/esnext.symbol.replace-all.js"),e.exports=n},"./node_modules/core-js-pure/features/symbol/iterator.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/symbol/iterator.js");e.exports=n},"./node_modules/core-js-pure/internals/a-function.js":function(e){e.exports=function(e){if("function"!=typeof e)throw TypeError(String(e)+" is not a function");return e}},"./node_modules/core-js-pure/internals/a-possible-prototype.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/is-object.js");e.exports=function(e){if(!n(e)&&null!==e)throw TypeError("Can't set "+String(e)+" as a prototype");return e}},"./node_modules/core-js-pure/internals/add-to-unscopables.js":function(e){e.exports=function(){}},"./node_modules/core-js-pure/internals/an-instance.js":function(e){e.exports=function(e,t,r){if(!(e instanceof t))throw TypeError("Incorrect "+(r?r+" ":"")+"invocation");return e}},"./node_modules/core-js-pure/internals/an-object.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/is-object.js");e.exports=function(e){if(!n(e))throw TypeError(String(e)+" is not an object");return e}},"./node_modules/core-js-pure/internals/array-fill.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/to-object.js"),o=r("./node_modules/core-js-pure/internals/to-absolute-index.js"),s=r("./node_modules/core-js-pure/internals/to-length.js");e.exports=function(e){for(var t=n(this),r=s(t.length),i=arguments.length,a=o(i>1?arguments[1]:void 0,r),A=i>2?arguments[2]:void 0,u=void 0===A?r:o(A,r);u>a;)t[a++]=e;return t}},"./node_modules/core-js-pure/internals/array-for-each.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/array-iteration.js").forEach,o=r("./node_modules/core-js-pure/internals/array-method-is-strict.js")("forEach");e.exports=o?[].forEach:function(e){return n(this,e,arguments.length>1?arguments[1]:void 0)}},"./node_modules/core-js-pure/internals/array-from.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/function-bind-context.js"),o=r("./node_modules/core-js-pure/internals/to-object.js"),s=r("./node_modules/core-js-pure/internals/call-with-safe-iteration-closing.js"),i=r("./node_modules/core-js-pure/internals/is-array-iterator-method.js"),a=r("./node_modules/core-js-pure/internals/to-length.js"),A=r("./node_modules/core-js-pure/internals/create-property.js"),u=r("./node_modules/core-js-pure/internals/get-iterator-method.js");e.exports=function(e){var t,r,c,l,d,f,h=o(e),p="function"==typeof this?this:Array,m=arguments.length,g=m>1?arguments[1]:void 0,y=void 0!==g,v=u(h),w=0;if(y&&(g=n(g,m>2?arguments[2]:void 0,2)),null==v||p==Array&&i(v))for(r=new p(t=a(h.length));t>w;w++)f=y?g(h[w],w):h[w],A(r,w,f);else for(d=(l=v.call(h)).next,r=new p;!(c=d.call(l)).done;w++)f=y?s(l,g,[c.value,w],!0):c.value,A(r,w,f);return r.length=w,r}},"./node_modules/core-js-pure/internals/array-includes.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/to-indexed-object.js"),o=r("./node_modules/core-js-pure/internals/to-length.js"),s=r("./node_modules/core-js-pure/internals/to-absolute-index.js"),i=function(e){return function(t,r,i){var a,A=n(t),u=o(A.length),c=s(i,u);if(e&&r!=r){for(;u>c;)if((a=A[c++])!=a)return!0}else for(;u>c;c++)if((e||c in A)&&A[c]===r)return e||c||0;return!e&&-1}};e.exports={includes:i(!0),indexOf:i(!1)}},"./node_modules/core-js-pure/internals/array-iteration.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/function-bind-context.js"),o=r("./node_modules/core-js-pure/internals/indexed-object.js"),s=r("./node_modules/core-js-pure/internals/to-object.js"),i=r("./node_modules/core-js-pure/internals/to-length.js"),a=r("./node_modules/core-js-pure/internals/array-species-create.js"),A=[].push,u=function(e){var t=1==e,r=2==e,u=3==e,c=4==e,l=6==e,d=7==e,f=5==e||l;return function(h,p,m,g){for(var y,v,w=s(h),b=o(w),B=n(p,m,3),j=i(b.length),_=0,C=g||a,x=t?C(h,j):r||d?C(h,0):void 0;j>_;_++)if((f||_ in b)&&(v=B(y=b[_],_,w),e))if(t)x[_]=v;else if(v)switch(e){case 3:return!0;case 5:return y;case 6:return _;case 2:A.call(x,y)}else switch(e){case 4:return!1;case 7:A.call(x,y)}return l?-1:u||c?c:x}};e.exports={forEach:u(0),map:u(1),filter:u(2),some:u(3),every:u(4),find:u(5),findIndex:u(6),filterOut:u(7)}},"./node_modules/core-js-pure/internals/array-method-has-species-support.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/fails.js"),o=r("./node_modules/core-js-pure/internals/well-known-symbol.js"),s=r("./node_modules/core-js-pure/internals/engine-v8-version.js"),i=o("species");e.exports=function(e){return s>=51||!n((function(){var t=[];return(t.constructor={})[i]=function(){return{foo:1}},1!==t[e](Boolean).foo}))}},"./node_modules/core-js-pure/internals/array-method-is-strict.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/fails.js");e.exports=function(e,t){var r=[][e];return!!r&&n((function(){r.call(null,t||function(){throw 1},1)}))}},"./node_modules/core-js-pure/internals/array-reduce.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/a-function.js"),o=r("./node_modules/core-js-pure/internals/to-object.js"),s=r("./node_modules/core-js-pure/internals/indexed-object.js"),i=r("./node_modules/core-js-pure/internals/to-length.js"),a=function(e){return function(t,r,a,A){n(r);var u=o(t),c=s(u),l=i(u.length),d=e?l-1:0,f=e?-1:1;if(a<2)for(;;){if(d in c){A=c[d],d+=f;break}if(d+=f,e?d<0:l<=d)throw TypeError("Reduce of empty array with no initial value")}for(;e?d>=0:l>d;d+=f)d in c&&(A=r(A,c[d],d,u));return A}};e.exports={left:a(!1),right:a(!0)}},"./node_modules/core-js-pure/internals/array-species-create.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/is-object.js"),o=r("./node_modules/core-js-pure/internals/is-array.js"),s=r("./node_modules/core-js-pure/internals/well-known-symbol.js")("species");e.exports=function(e,t){var r;return o(e)&&("function"!=typeof(r=e.constructor)||r!==Array&&!o(r.prototype)?n(r)&&null===(r=r[s])&&(r=void 0):r=void 0),new(void 0===r?Array:r)(0===t?0:t)}},"./node_modules/core-js-pure/internals/call-with-safe-iteration-closing.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/an-object.js"),o=r("./node_modules/core-js-pure/internals/iterator-close.js");e.exports=function(e,t,r,s){try{return s?t(n(r)[0],r[1]):t(r)}catch(t){throw o(e),t}}},"./node_modules/core-js-pure/internals/check-correctness-of-iteration.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/well-known-symbol.js")("iterator"),o=!1;try{var s=0,i={next:function(){return{done:!!s++}},return:function(){o=!0}};i[n]=function(){return this},Array.from(i,(function(){throw 2}))}catch(e){}e.exports=function(e,t){if(!t&&!o)return!1;var r=!1;try{var s={};s[n]=function(){return{next:function(){return{done:r=!0}}}},e(s)}catch(e){}return r}},"./node_modules/core-js-pure/internals/classof-raw.js":function(e){var t={}.toString;e.exports=function(e){return t.call(e).slice(8,-1)}},"./node_modules/core-js-pure/internals/classof.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/to-string-tag-support.js"),o=r("./node_modules/core-js-pure/internals/classof-raw.js"),s=r("./node_modules/core-js-pure/internals/well-known-symbol.js")("toStringTag"),i="Arguments"==o(function(){return arguments}());e.exports=n?o:function(e){var t,r,n;return void 0===e?"Undefined":null===e?"Null":"string"==typeof(r=function(e,t){try{return e[t]}catch(e){}}(t=Object(e),s))?r:i?o(t):"Object"==(n=o(t))&&"function"==typeof t.callee?"Arguments":n}},"./node_modules/core-js-pure/internals/collection-strong.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/object-define-property.js").f,o=r("./node_modules/core-js-pure/internals/object-create.js"),s=r("./node_modules/core-js-pure/internals/redefine-all.js"),i=r("./node_modules/core-js-pure/internals/function-bind-context.js"),a=r("./node_modules/core-js-pure/internals/an-instance.js"),A=r("./node_modules/core-js-pure/internals/iterate.js"),u=r("./node_modules/core-js-pure/internals/define-iterator.js"),c=r("./node_modules/core-js-pure/internals/set-species.js"),l=r("./node_modules/core-js-pure/internals/descriptors.js"),d=r("./node_modules/core-js-pure/internals/internal-metadata.js").fastKey,f=r("./node_modules/core-js-pure/internals/internal-state.js"),h=f.set,p=f.getterFor;e.exports={getConstructor:function(e,t,r,u){var c=e((function(e,n){a(e,c,t),h(e,{type:t,index:o(null),first:void 0,last:void 0,size:0}),l||(e.size=0),null!=n&&A(n,e[u],{that:e,AS_ENTRIES:r})})),f=p(t),m=function(e,t,r){var n,o,s=f(e),i=g(e,t);return i?i.value=r:(s.last=i={index:o=d(t,!0),key:t,value:r,previous:n=s.last,next:void 0,removed:!1},s.first||(s.first=i),n&&(n.next=i),l?s.size++:e.size++,"F"!==o&&(s.index[o]=i)),e},g=function(e,t){var r,n=f(e),o=d(t);if("F"!==o)return n.index[o];for(r=n.first;r;r=r.next)if(r.key==t)return r};return s(c.prototype,{clear:function(){for(var e=f(this),t=e.index,r=e.first;r;)r.removed=!0,r.previous&&(r.previous=r.previous.next=void 0),delete t[r.index],r=r.next;e.first=e.last=void 0,l?e.size=0:this.size=0},delete:function(e){var t=this,r=f(t),n=g(t,e);if(n){var o=n.next,s=n.previous;delete r.index[n.index],n.removed=!0,s&&(s.next=o),o&&(o.previous=s),r.first==n&&(r.first=o),r.last==n&&(r.last=s),l?r.size--:t.size--}return!!n},forEach:function(e){for(var t,r=f(this),n=i(e,arguments.length>1?arguments[1]:void 0,3);t=t?t.next:r.first;)for(n(t.value,t.key,this);t&&t.removed;)t=t.previous},has:function(e){return!!g(this,e)}}),s(c.prototype,r?{get:function(e){var t=g(this,e);return t&&t.value},set:function(e,t){return m(this,0===e?0:e,t)}}:{add:function(e){return m(this,e=0===e?0:e,e)}}),l&&n(c.prototype,"size",{get:function(){return f(this).size}}),c},setStrong:function(e,t,r){var n=t+" Iterator",o=p(t),s=p(n);u(e,t,(function(e,t){h(this,{type:n,target:e,state:o(e),kind:t,last:void 0})}),(function(){for(var e=s(this),t=e.kind,r=e.last;r&&r.removed;)r=r.previous;return e.target&&(e.last=r=r?r.next:e.state.first)?"keys"==t?{value:r.key,done:!1}:"values"==t?{value:r.value,done:!1}:{value:[r.key,r.value],done:!1}:(e.target=void 0,{value:void 0,done:!0})}),r?"entries":"values",!r,!0),c(t)}}},"./node_modules/core-js-pure/internals/collection.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/global.js"),s=r("./node_modules/core-js-pure/internals/internal-metadata.js"),i=r("./node_modules/core-js-pure/internals/fails.js"),a=r("./node_modules/core-js-pure/internals/create-non-enumerable-property.js"),A=r("./node_modules/core-js-pure/internals/iterate.js"),u=r("./node_modules/core-js-pure/internals/an-instance.js"),c=r("./node_modules/core-js-pure/internals/is-object.js"),l=r("./node_modules/core-js-pure/internals/set-to-string-tag.js"),d=r("./node_modules/core-js-pure/internals/object-define-property.js").f,f=r("./node_modules/core-js-pure/internals/array-iteration.js").forEach,h=r("./node_modules/core-js-pure/internals/descriptors.js"),p=r("./node_modules/core-js-pure/internals/internal-state.js"),m=p.set,g=p.getterFor;e.exports=function(e,t,r){var p,y=-1!==e.indexOf("Map"),v=-1!==e.indexOf("Weak"),w=y?"set":"add",b=o[e],B=b&&b.prototype,j={};if(h&&"function"==typeof b&&(v||B.forEach&&!i((function(){(new b).entries().next()})))){p=t((function(t,r){m(u(t,p,e),{type:e,collection:new b}),null!=r&&A(r,t[w],{that:t,AS_ENTRIES:y})}));var _=g(e);f(["add","clear","delete","forEach","get","has","set","keys","values","entries"],(function(e){var t="add"==e||"set"==e;!(e in B)||v&&"clear"==e||a(p.prototype,e,(function(r,n){var o=_(this).collection;if(!t&&v&&!c(r))return"get"==e&&void 0;var s=o[e](0===r?0:r,n);return t?this:s}))})),v||d(p.prototype,"size",{configurable:!0,get:function(){return _(this).collection.size}})}else p=r.getConstructor(t,e,y,w),s.REQUIRED=!0;return l(p,e,!1,!0),j[e]=p,n({global:!0,forced:!0},j),v||r.setStrong(p,e,y),p}},"./node_modules/core-js-pure/internals/correct-is-regexp-logic.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/well-known-symbol.js")("match");e.exports=function(e){var t=/./;try{"/./"[e](t)}catch(r){try{return t[n]=!1,"/./"[e](t)}catch(e){}}return!1}},"./node_modules/core-js-pure/internals/correct-prototype-getter.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/fails.js");e.exports=!n((function(){function e(){}return e.prototype.constructor=null,Object.getPrototypeOf(new e)!==e.prototype}))},"./node_modules/core-js-pure/internals/create-iterator-constructor.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/iterators-core.js").IteratorPrototype,o=r("./node_modules/core-js-pure/internals/object-create.js"),s=r("./node_modules/core-js-pure/internals/create-property-descriptor.js"),i=r("./node_modules/core-js-pure/internals/set-to-string-tag.js"),a=r("./node_modules/core-js-pure/internals/iterators.js"),A=function(){return this};e.exports=function(e,t,r){var u=t+" Iterator";return e.prototype=o(n,{next:s(1,r)}),i(e,u,!1,!0),a[u]=A,e}},"./node_modules/core-js-pure/internals/create-non-enumerable-property.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/descriptors.js"),o=r("./node_modules/core-js-pure/internals/object-define-property.js"),s=r("./node_modules/core-js-pure/internals/create-property-descriptor.js");e.exports=n?function(e,t,r){return o.f(e,t,s(1,r))}:function(e,t,r){return e[t]=r,e}},"./node_modules/core-js-pure/internals/create-property-descriptor.js":function(e){e.exports=function(e,t){return{enumerable:!(1&e),configurable:!(2&e),writable:!(4&e),value:t}}},"./node_modules/core-js-pure/internals/create-property.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/to-primitive.js"),o=r("./node_modules/core-js-pure/internals/object-define-property.js"),s=r("./node_modules/core-js-pure/internals/create-property-descriptor.js");e.exports=function(e,t,r){var i=n(t);i in e?o.f(e,i,s(0,r)):e[i]=r}},"./node_modules/core-js-pure/internals/define-iterator.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/create-iterator-constructor.js"),s=r("./node_modules/core-js-pure/internals/object-get-prototype-of.js"),i=r("./node_modules/core-js-pure/internals/object-set-prototype-of.js"),a=r("./node_modules/core-js-pure/internals/set-to-string-tag.js"),A=r("./node_modules/core-js-pure/internals/create-non-enumerable-property.js"),u=r("./node_modules/core-js-pure/internals/redefine.js"),c=r("./node_modules/core-js-pure/internals/well-known-symbol.js"),l=r("./node_modules/core-js-pure/internals/is-pure.js"),d=r("./node_modules/core-js-pure/internals/iterators.js"),f=r("./node_modules/core-js-pure/internals/iterators-core.js"),h=f.IteratorPrototype,p=f.BUGGY_SAFARI_ITERATORS,m=c("iterator"),g="keys",y="values",v="entries",w=function(){return this};e.exports=function(e,t,r,c,f,b,B){o(r,t,c);var j,_,C,x=function(e){if(e===f&&U)return U;if(!p&&e in Q)return Q[e];switch(e){case g:case y:case v:return function(){return new r(this,e)}}return function(){return new r(this)}},E=t+" Iterator",N=!1,Q=e.prototype,F=Q[m]||Q["@@iterator"]||f&&Q[f],U=!p&&F||x(f),S="Array"==t&&Q.entries||F;if(S&&(j=s(S.call(new e)),h!==Object.prototype&&j.next&&(l||s(j)===h||(i?i(j,h):"function"!=typeof j[m]&&A(j,m,w)),a(j,E,!0,!0),l&&(d[E]=w))),f==y&&F&&F.name!==y&&(N=!0,U=function(){return F.call(this)}),l&&!B||Q[m]===U||A(Q,m,U),d[t]=U,f)if(_={values:x(y),keys:b?U:x(g),entries:x(v)},B)for(C in _)(p||N||!(C in Q))&&u(Q,C,_[C]);else n({target:t,proto:!0,forced:p||N},_);return _}},"./node_modules/core-js-pure/internals/define-well-known-symbol.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/path.js"),o=r("./node_modules/core-js-pure/internals/has.js"),s=r("./node_modules/core-js-pure/internals/well-known-symbol-wrapped.js"),i=r("./node_modules/core-js-pure/internals/object-define-property.js").f;e.exports=function(e){var t=n.Symbol||(n.Symbol={});o(t,e)||i(t,e,{value:s.f(e)})}},"./node_modules/core-js-pure/internals/descriptors.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/fails.js");e.exports=!n((function(){return 7!=Object.defineProperty({},1,{get:function(){return 7}})[1]}))},"./node_modules/core-js-pure/internals/document-create-element.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/global.js"),o=r("./node_modules/core-js-pure/internals/is-object.js"),s=n.document,i=o(s)&&o(s.createElement);e.exports=function(e){return i?s.createElement(e):{}}},"./node_modules/core-js-pure/internals/dom-iterables.js":function(e){e.exports={CSSRuleList:0,CSSStyleDeclaration:0,CSSValueList:0,ClientRectList:0,DOMRectList:0,DOMStringList:0,DOMTokenList:1,DataTransferItemList:0,FileList:0,HTMLAllCollection:0,HTMLCollection:0,HTMLFormElement:0,HTMLSelectElement:0,MediaList:0,MimeTypeArray:0,NamedNodeMap:0,NodeList:1,PaintRequestList:0,Plugin:0,PluginArray:0,SVGLengthList:0,SVGNumberList:0,SVGPathSegList:0,SVGPointList:0,SVGStringList:0,SVGTransformList:0,SourceBufferList:0,StyleSheetList:0,TextTrackCueList:0,TextTrackList:0,TouchList:0}},"./node_modules/core-js-pure/internals/engine-is-browser.js":function(e){e.exports="object"==typeof window},"./node_modules/core-js-pure/internals/engine-is-ios.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/engine-user-agent.js");e.exports=/(?:iphone|ipod|ipad).*applewebkit/i.test(n)},"./node_modules/core-js-pure/internals/engine-is-node.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/classof-raw.js"),o=r("./node_modules/core-js-pure/internals/global.js");e.exports="process"==n(o.process)},"./node_modules/core-js-pure/internals/engine-is-webos-webkit.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/engine-user-agent.js");e.exports=/web0s(?!.*chrome)/i.test(n)},"./node_modules/core-js-pure/internals/engine-user-agent.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/get-built-in.js");e.exports=n("navigator","userAgent")||""},"./node_modules/core-js-pure/internals/engine-v8-version.js":function(e,t,r){var n,o,s=r("./node_modules/core-js-pure/internals/global.js"),i=r("./node_modules/core-js-pure/internals/engine-user-agent.js"),a=s.process,A=a&&a.versions,u=A&&A.v8;u?o=(n=u.split("."))[0]<4?1:n[0]+n[1]:i&&(!(n=i.match(/Edge\/(\d+)/))||n[1]>=74)&&(n=i.match(/Chrome\/(\d+)/))&&(o=n[1]),e.exports=o&&+o},"./node_modules/core-js-pure/internals/entry-virtual.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/path.js");e.exports=function(e){return n[e+"Prototype"]}},"./node_modules/core-js-pure/internals/enum-bug-keys.js":function(e){e.exports=["constructor","hasOwnProperty","isPrototypeOf","propertyIsEnumerable","toLocaleString","toString","valueOf"]},"./node_modules/core-js-pure/internals/export.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/global.js"),o=r("./node_modules/core-js-pure/internals/object-get-own-property-descriptor.js").f,s=r("./node_modules/core-js-pure/internals/is-forced.js"),i=r("./node_modules/core-js-pure/internals/path.js"),a=r("./node_modules/core-js-pure/internals/function-bind-context.js"),A=r("./node_modules/core-js-pure/internals/create-non-enumerable-property.js"),u=r("./node_modules/core-js-pure/internals/has.js"),c=function(e){var t=function(t,r,n){if(this instanceof e){switch(arguments.length){case 0:return new e;case 1:return new e(t);case 2:return new e(t,r)}return new e(t,r,n)}return e.apply(this,arguments)};return t.prototype=e.prototype,t};e.exports=function(e,t){var r,l,d,f,h,p,m,g,y=e.target,v=e.global,w=e.stat,b=e.proto,B=v?n:w?n[y]:(n[y]||{}).prototype,j=v?i:i[y]||(i[y]={}),_=j.prototype;for(d in t)r=!s(v?d:y+(w?".":"#")+d,e.forced)&&B&&u(B,d),h=j[d],r&&(p=e.noTargetGet?(g=o(B,d))&&g.value:B[d]),f=r&&p?p:t[d],r&&typeof h==typeof f||(m=e.bind&&r?a(f,n):e.wrap&&r?c(f):b&&"function"==typeof f?a(Function.call,f):f,(e.sham||f&&f.sham||h&&h.sham)&&A(m,"sham",!0),j[d]=m,b&&(u(i,l=y+"Prototype")||A(i,l,{}),i[l][d]=f,e.real&&_&&!_[d]&&A(_,d,f)))}},"./node_modules/core-js-pure/internals/fails.js":function(e){e.exports=function(e){try{return!!e()}catch(e){return!0}}},"./node_modules/core-js-pure/internals/freezing.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/fails.js");e.exports=!n((function(){return Object.isExtensible(Object.preventExtensions({}))}))},"./node_modules/core-js-pure/internals/function-bind-context.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/a-function.js");e.exports=function(e,t,r){if(n(e),void 0===t)return e;switch(r){case 0:return function(){return e.call(t)};case 1:return function(r){return e.call(t,r)};case 2:return function(r,n){return e.call(t,r,n)};case 3:return function(r,n,o){return e.call(t,r,n,o)}}return function(){return e.apply(t,arguments)}}},"./node_modules/core-js-pure/internals/function-bind.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/a-function.js"),o=r("./node_modules/core-js-pure/internals/is-object.js"),s=[].slice,i={},a=function(e,t,r){if(!(t in i)){for(var n=[],o=0;o<t;o++)n[o]="a["+o+"]";i[t]=Function("C,a","return new C("+n.join(",")+")")}return i[t](e,r)};e.exports=Function.bind||function(e){var t=n(this),r=s.call(arguments,1),i=function(){var n=r.concat(s.call(arguments));return this instanceof i?a(t,n.length,n):t.apply(e,n)};return o(t.prototype)&&(i.prototype=t.prototype),i}},"./node_modules/core-js-pure/internals/get-built-in.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/path.js"),o=r("./node_modules/core-js-pure/internals/global.js"),s=function(e){return"function"==typeof e?e:void 0};e.exports=function(e,t){return arguments.length<2?s(n[e])||s(o[e]):n[e]&&n[e][t]||o[e]&&o[e][t]}},"./node_modules/core-js-pure/internals/get-iterator-method.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/classof.js"),o=r("./node_modules/core-js-pure/internals/iterators.js"),s=r("./node_modules/core-js-pure/internals/well-known-symbol.js")("iterator");e.exports=function(e){if(null!=e)return e[s]||e["@@iterator"]||o[n(e)]}},"./node_modules/core-js-pure/internals/get-iterator.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/an-object.js"),o=r("./node_modules/core-js-pure/internals/get-iterator-method.js");e.exports=function(e){var t=o(e);if("function"!=typeof t)throw TypeError(String(e)+" is not iterable");return n(t.call(e))}},"./node_modules/core-js-pure/internals/global.js":function(e){var t=function(e){return e&&e.Math==Math&&e};e.exports=t("object"==typeof globalThis&&globalThis)||t("object"==typeof window&&window)||t("object"==typeof self&&self)||t("object"==typeof global&&global)||function(){return this}()||Function("return this")()},"./node_modules/core-js-pure/internals/has.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/to-object.js"),o={}.hasOwnProperty;e.exports=Object.hasOwn||function(e,t){return o.call(n(e),t)}},"./node_modules/core-js-pure/internals/hidden-keys.js":function(e){e.exports={}},"./node_modules/core-js-pure/internals/host-report-errors.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/global.js");e.exports=function(e,t){var r=n.console;r&&r.error&&(1===arguments.length?r.error(e):r.error(e,t))}},"./node_modules/core-js-pure/internals/html.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/get-built-in.js");e.exports=n("document","documentElement")},"./node_modules/core-js-pure/internals/ie8-dom-define.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/descriptors.js"),o=r("./node_modules/core-js-pure/internals/fails.js"),s=r("./node_modules/core-js-pure/internals/document-create-element.js");e.exports=!n&&!o((function(){return 7!=Object.defineProperty(s("div"),"a",{get:function(){return 7}}).a}))},"./node_modules/core-js-pure/internals/indexed-object.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/fails.js"),o=r("./node_modules/core-js-pure/internals/classof-raw.js"),s="".split;e.exports=n((function(){return!Object("z").propertyIsEnumerable(0)}))?function(e){return"String"==o(e)?s.call(e,""):Object(e)}:Object},"./node_modules/core-js-pure/internals/inspect-source.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/shared-store.js"),o=Function.toString;"function"!=typeof n.inspectSource&&(n.inspectSource=function(e){return o.call(e)}),e.exports=n.inspectSource},"./node_modules/core-js-pure/internals/internal-metadata.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/hidden-keys.js"),o=r("./node_modules/core-js-pure/internals/is-object.js"),s=r("./node_modules/core-js-pure/internals/has.js"),i=r("./node_modules/core-js-pure/internals/object-define-property.js").f,a=r("./node_modules/core-js-pure/internals/uid.js"),A=r("./node_modules/core-js-pure/internals/freezing.js"),u=a("meta"),c=0,l=Object.isExtensible||function(){return!0},d=function(e){i(e,u,{value:{objectID:"O"+c++,weakData:{}}})},f=e.exports={REQUIRED:!1,fastKey:function(e,t){if(!o(e))return"symbol"==typeof e?e:("string"==typeof e?"S":"P")+e;if(!s(e,u)){if(!l(e))return"F";if(!t)return"E";d(e)}return e[u].objectID},getWeakData:function(e,t){if(!s(e,u)){if(!l(e))return!0;if(!t)return!1;d(e)}return e[u].weakData},onFreeze:function(e){return A&&f.REQUIRED&&l(e)&&!s(e,u)&&d(e),e}};n[u]=!0},"./node_modules/core-js-pure/internals/internal-state.js":function(e,t,r){var n,o,s,i=r("./node_modules/core-js-pure/internals/native-weak-map.js"),a=r("./node_modules/core-js-pure/internals/global.js"),A=r("./node_modules/core-js-pure/internals/is-object.js"),u=r("./node_modules/core-js-pure/internals/create-non-enumerable-property.js"),c=r("./node_modules/core-js-pure/internals/has.js"),l=r("./node_modules/core-js-pure/internals/shared-store.js"),d=r("./node_modules/core-js-pure/internals/shared-key.js"),f=r("./node_modules/core-js-pure/internals/hidden-keys.js"),h="Object already initialized",p=a.WeakMap;if(i||l.state){var m=l.state||(l.state=new p),g=m.get,y=m.has,v=m.set;n=function(e,t){if(y.call(m,e))throw new TypeError(h);return t.facade=e,v.call(m,e,t),t},o=function(e){return g.call(m,e)||{}},s=function(e){return y.call(m,e)}}else{var w=d("state");f[w]=!0,n=function(e,t){if(c(e,w))throw new TypeError(h);return t.facade=e,u(e,w,t),t},o=function(e){return c(e,w)?e[w]:{}},s=function(e){return c(e,w)}}e.exports={set:n,get:o,has:s,enforce:function(e){return s(e)?o(e):n(e,{})},getterFor:function(e){return function(t){var r;if(!A(t)||(r=o(t)).type!==e)throw TypeError("Incompatible receiver, "+e+" required");return r}}}},"./node_modules/core-js-pure/internals/is-array-iterator-method.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/well-known-symbol.js"),o=r("./node_modules/core-js-pure/internals/iterators.js"),s=n("iterator"),i=Array.prototype;e.exports=function(e){return void 0!==e&&(o.Array===e||i[s]===e)}},"./node_modules/core-js-pure/internals/is-array.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/classof-raw.js");e.exports=Array.isArray||function(e){return"Array"==n(e)}},"./node_modules/core-js-pure/internals/is-forced.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/fails.js"),o=/#|\.prototype\./,s=function(e,t){var r=a[i(e)];return r==u||r!=A&&("function"==typeof t?n(t):!!t)},i=s.normalize=function(e){return String(e).replace(o,".").toLowerCase()},a=s.data={},A=s.NATIVE="N",u=s.POLYFILL="P";e.exports=s},"./node_modules/core-js-pure/internals/is-object.js":function(e){e.exports=function(e){return"object"==typeof e?null!==e:"function"==typeof e}},"./node_modules/core-js-pure/internals/is-pure.js":function(e){e.exports=!0},"./node_modules/core-js-pure/internals/is-regexp.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/is-object.js"),o=r("./node_modules/core-js-pure/internals/classof-raw.js"),s=r("./node_modules/core-js-pure/internals/well-known-symbol.js")("match");e.exports=function(e){var t;return n(e)&&(void 0!==(t=e[s])?!!t:"RegExp"==o(e))}},"./node_modules/core-js-pure/internals/iterate.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/an-object.js"),o=r("./node_modules/core-js-pure/internals/is-array-iterator-method.js"),s=r("./node_modules/core-js-pure/internals/to-length.js"),i=r("./node_modules/core-js-pure/internals/function-bind-context.js"),a=r("./node_modules/core-js-pure/internals/get-iterator-method.js"),A=r("./node_modules/core-js-pure/internals/iterator-close.js"),u=function(e,t){this.stopped=e,this.result=t};e.exports=function(e,t,r){var c,l,d,f,h,p,m,g=r&&r.that,y=!(!r||!r.AS_ENTRIES),v=!(!r||!r.IS_ITERATOR),w=!(!r||!r.INTERRUPTED),b=i(t,g,1+y+w),B=function(e){return c&&A(c),new u(!0,e)},j=function(e){return y?(n(e),w?b(e[0],e[1],B):b(e[0],e[1])):w?b(e,B):b(e)};if(v)c=e;else{if("function"!=typeof(l=a(e)))throw TypeError("Target is not iterable");if(o(l)){for(d=0,f=s(e.length);f>d;d++)if((h=j(e[d]))&&h instanceof u)return h;return new u(!1)}c=l.call(e)}for(p=c.next;!(m=p.call(c)).done;){try{h=j(m.value)}catch(e){throw A(c),e}if("object"==typeof h&&h&&h instanceof u)return h}return new u(!1)}},"./node_modules/core-js-pure/internals/iterator-close.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/an-object.js");e.exports=function(e){var t=e.return;if(void 0!==t)return n(t.call(e)).value}},"./node_modules/core-js-pure/internals/iterators-core.js":function(e,t,r){"use strict";var n,o,s,i=r("./node_modules/core-js-pure/internals/fails.js"),a=r("./node_modules/core-js-pure/internals/object-get-prototype-of.js"),A=r("./node_modules/core-js-pure/internals/create-non-enumerable-property.js"),u=r("./node_modules/core-js-pure/internals/has.js"),c=r("./node_modules/core-js-pure/internals/well-known-symbol.js"),l=r("./node_modules/core-js-pure/internals/is-pure.js"),d=c("iterator"),f=!1;[].keys&&("next"in(s=[].keys())?(o=a(a(s)))!==Object.prototype&&(n=o):f=!0);var h=null==n||i((function(){var e={};return n[d].call(e)!==e}));h&&(n={}),l&&!h||u(n,d)||A(n,d,(function(){return this})),e.exports={IteratorPrototype:n,BUGGY_SAFARI_ITERATORS:f}},"./node_modules/core-js-pure/internals/iterators.js":function(e){e.exports={}},"./node_modules/core-js-pure/internals/microtask.js":function(e,t,r){var n,o,s,i,a,A,u,c,l=r("./node_modules/core-js-pure/internals/global.js"),d=r("./node_modules/core-js-pure/internals/object-get-own-property-descriptor.js").f,f=r("./node_modules/core-js-pure/internals/task.js").set,h=r("./node_modules/core-js-pure/internals/engine-is-ios.js"),p=r("./node_modules/core-js-pure/internals/engine-is-webos-webkit.js"),m=r("./node_modules/core-js-pure/internals/engine-is-node.js"),g=l.MutationObserver||l.WebKitMutationObserver,y=l.document,v=l.process,w=l.Promise,b=d(l,"queueMicrotask"),B=b&&b.value;B||(n=function(){var e,t;for(m&&(e=v.domain)&&e.exit();o;){t=o.fn,o=o.next;try{t()}catch(e){throw o?i():s=void 0,e}}s=void 0,e&&e.enter()},h||m||p||!g||!y?w&&w.resolve?((u=w.resolve(void 0)).constructor=w,c=u.then,i=function(){c.call(u,n)}):i=m?function(){v.nextTick(n)}:function(){f.call(l,n)}:(a=!0,A=y.createTextNode(""),new g(n).observe(A,{characterData:!0}),i=function(){A.data=a=!a})),e.exports=B||function(e){var t={fn:e,next:void 0};s&&(s.next=t),o||(o=t,i()),s=t}},"./node_modules/core-js-pure/internals/native-promise-constructor.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/global.js");e.exports=n.Promise},"./node_modules/core-js-pure/internals/native-symbol.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/engine-v8-version.js"),o=r("./node_modules/core-js-pure/internals/fails.js");e.exports=!!Object.getOwnPropertySymbols&&!o((function(){var e=Symbol();return!String(e)||!(Object(e)instanceof Symbol)||!Symbol.sham&&n&&n<41}))},"./node_modules/core-js-pure/internals/native-weak-map.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/global.js"),o=r("./node_modules/core-js-pure/internals/inspect-source.js"),s=n.WeakMap;e.exports="function"==typeof s&&/native code/.test(o(s))},"./node_modules/core-js-pure/internals/new-promise-capability.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/a-function.js"),o=function(e){var t,r;this.promise=new e((function(e,n){if(void 0!==t||void 0!==r)throw TypeError("Bad Promise constructor");t=e,r=n})),this.resolve=n(t),this.reject=n(r)};e.exports.f=function(e){return new o(e)}},"./node_modules/core-js-pure/internals/not-a-regexp.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/is-regexp.js");e.exports=function(e){if(n(e))throw TypeError("The method doesn't accept regular expressions");return e}},"./node_modules/core-js-pure/internals/number-parse-float.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/global.js"),o=r("./node_modules/core-js-pure/internals/string-trim.js").trim,s=r("./node_modules/core-js-pure/internals/whitespaces.js"),i=n.parseFloat,a=1/i(s+"-0")!=-1/0;e.exports=a?function(e){var t=o(String(e)),r=i(t);return 0===r&&"-"==t.charAt(0)?-0:r}:i},"./node_modules/core-js-pure/internals/number-parse-int.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/global.js"),o=r("./node_modules/core-js-pure/internals/string-trim.js").trim,s=r("./node_modules/core-js-pure/internals/whitespaces.js"),i=n.parseInt,a=/^[+-]?0[Xx]/,A=8!==i(s+"08")||22!==i(s+"0x16");e.exports=A?function(e,t){var r=o(String(e));return i(r,t>>>0||(a.test(r)?16:10))}:i},"./node_modules/core-js-pure/internals/object-create.js":function(e,t,r){var n,o=r("./node_modules/core-js-pure/internals/an-object.js"),s=r("./node_modules/core-js-pure/internals/object-define-properties.js"),i=r("./node_modules/core-js-pure/internals/enum-bug-keys.js"),a=r("./node_modules/core-js-pure/internals/hidden-keys.js"),A=r("./node_modules/core-js-pure/internals/html.js"),u=r("./node_modules/core-js-pure/internals/document-create-element.js"),c=r("./node_modules/core-js-pure/internals/shared-key.js")("IE_PROTO"),l=function(){},d=function(e){return"<script>"+e+"<\/script>"},f=function(){try{n=document.domain&&new ActiveXObject("htmlfile")}catch(e){}var e,t;f=n?function(e){e.write(d("")),e.close();var t=e.parentWindow.Object;return e=null,t}(n):((t=u("iframe")).style.display="none",A.appendChild(t),t.src=String("javascript:"),(e=t.contentWindow.document).open(),e.write(d("document.F=Object")),e.close(),e.F);for(var r=i.length;r--;)delete f.prototype[i[r]];return f()};a[c]=!0,e.exports=Object.create||function(e,t){var r;return null!==e?(l.prototype=o(e),r=new l,l.prototype=null,r[c]=e):r=f(),void 0===t?r:s(r,t)}},"./node_modules/core-js-pure/internals/object-define-properties.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/descriptors.js"),o=r("./node_modules/core-js-pure/internals/object-define-property.js"),s=r("./node_modules/core-js-pure/internals/an-object.js"),i=r("./node_modules/core-js-pure/internals/object-keys.js");e.exports=n?Object.defineProperties:function(e,t){s(e);for(var r,n=i(t),a=n.length,A=0;a>A;)o.f(e,r=n[A++],t[r]);return e}},"./node_modules/core-js-pure/internals/object-define-property.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/descriptors.js"),o=r("./node_modules/core-js-pure/internals/ie8-dom-define.js"),s=r("./node_modules/core-js-pure/internals/an-object.js"),i=r("./node_modules/core-js-pure/internals/to-primitive.js"),a=Object.defineProperty;t.f=n?a:function(e,t,r){if(s(e),t=i(t,!0),s(r),o)try{return a(e,t,r)}catch(e){}if("get"in r||"set"in r)throw TypeError("Accessors not supported");return"value"in r&&(e[t]=r.value),e}},"./node_modules/core-js-pure/internals/object-get-own-property-descriptor.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/descriptors.js"),o=r("./node_modules/core-js-pure/internals/object-property-is-enumerable.js"),s=r("./node_modules/core-js-pure/internals/create-property-descriptor.js"),i=r("./node_modules/core-js-pure/internals/to-indexed-object.js"),a=r("./node_modules/core-js-pure/internals/to-primitive.js"),A=r("./node_modules/core-js-pure/internals/has.js"),u=r("./node_modules/core-js-pure/internals/ie8-dom-define.js"),c=Object.getOwnPropertyDescriptor;t.f=n?c:function(e,t){if(e=i(e),t=a(t,!0),u)try{return c(e,t)}catch(e){}if(A(e,t))return s(!o.f.call(e,t),e[t])}},"./node_modules/core-js-pure/internals/object-get-own-property-names-external.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/to-indexed-object.js"),o=r("./node_modules/core-js-pure/internals/object-get-own-property-names.js").f,s={}.toString,i="object"==typeof window&&window&&Object.getOwnPropertyNames?Object.getOwnPropertyNames(window):[];e.exports.f=function(e){return i&&"[object Window]"==s.call(e)?function(e){try{return o(e)}catch(e){return i.slice()}}(e):o(n(e))}},"./node_modules/core-js-pure/internals/object-get-own-property-names.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/object-keys-internal.js"),o=r("./node_modules/core-js-pure/internals/enum-bug-keys.js").concat("length","prototype");t.f=Object.getOwnPropertyNames||function(e){return n(e,o)}},"./node_modules/core-js-pure/internals/object-get-own-property-symbols.js":function(e,t){t.f=Object.getOwnPropertySymbols},"./node_modules/core-js-pure/internals/object-get-prototype-of.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/has.js"),o=r("./node_modules/core-js-pure/internals/to-object.js"),s=r("./node_modules/core-js-pure/internals/shared-key.js"),i=r("./node_modules/core-js-pure/internals/correct-prototype-getter.js"),a=s("IE_PROTO"),A=Object.prototype;e.exports=i?Object.getPrototypeOf:function(e){return e=o(e),n(e,a)?e[a]:"function"==typeof e.constructor&&e instanceof e.constructor?e.constructor.prototype:e instanceof Object?A:null}},"./node_modules/core-js-pure/internals/object-keys-internal.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/has.js"),o=r("./node_modules/core-js-pure/internals/to-indexed-object.js"),s=r("./node_modules/core-js-pure/internals/array-includes.js").indexOf,i=r("./node_modules/core-js-pure/internals/hidden-keys.js");e.exports=function(e,t){var r,a=o(e),A=0,u=[];for(r in a)!n(i,r)&&n(a,r)&&u.push(r);for(;t.length>A;)n(a,r=t[A++])&&(~s(u,r)||u.push(r));return u}},"./node_modules/core-js-pure/internals/object-keys.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/object-keys-internal.js"),o=r("./node_modules/core-js-pure/internals/enum-bug-keys.js");e.exports=Object.keys||function(e){return n(e,o)}},"./node_modules/core-js-pure/internals/object-property-is-enumerable.js":function(e,t){"use strict";var r={}.propertyIsEnumerable,n=Object.getOwnPropertyDescriptor,o=n&&!r.call({1:2},1);t.f=o?function(e){var t=n(this,e);return!!t&&t.enumerable}:r},"./node_modules/core-js-pure/internals/object-set-prototype-of.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/an-object.js"),o=r("./node_modules/core-js-pure/internals/a-possible-prototype.js");e.exports=Object.setPrototypeOf||("__proto__"in{}?function(){var e,t=!1,r={};try{(e=Object.getOwnPropertyDescriptor(Object.prototype,"__proto__").set).call(r,[]),t=r instanceof Array}catch(e){}return function(r,s){return n(r),o(s),t?e.call(r,s):r.__proto__=s,r}}():void 0)},"./node_modules/core-js-pure/internals/object-to-string.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/to-string-tag-support.js"),o=r("./node_modules/core-js-pure/internals/classof.js");e.exports=n?{}.toString:function(){return"[object "+o(this)+"]"}},"./node_modules/core-js-pure/internals/own-keys.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/get-built-in.js"),o=r("./node_modules/core-js-pure/internals/object-get-own-property-names.js"),s=r("./node_modules/core-js-pure/internals/object-get-own-property-symbols.js"),i=r("./node_modules/core-js-pure/internals/an-object.js");e.exports=n("Reflect","ownKeys")||function(e){var t=o.f(i(e)),r=s.f;return r?t.concat(r(e)):t}},"./node_modules/core-js-pure/internals/path.js":function(e){e.exports={}},"./node_modules/core-js-pure/internals/perform.js":function(e){e.exports=function(e){try{return{error:!1,value:e()}}catch(e){return{error:!0,value:e}}}},"./node_modules/core-js-pure/internals/promise-resolve.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/an-object.js"),o=r("./node_modules/core-js-pure/internals/is-object.js"),s=r("./node_modules/core-js-pure/internals/new-promise-capability.js");e.exports=function(e,t){if(n(e),o(t)&&t.constructor===e)return t;var r=s.f(e);return(0,r.resolve)(t),r.promise}},"./node_modules/core-js-pure/internals/redefine-all.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/redefine.js");e.exports=function(e,t,r){for(var o in t)r&&r.unsafe&&e[o]?e[o]=t[o]:n(e,o,t[o],r);return e}},"./node_modules/core-js-pure/internals/redefine.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/create-non-enumerable-property.js");e.exports=function(e,t,r,o){o&&o.enumerable?e[t]=r:n(e,t,r)}},"./node_modules/core-js-pure/internals/require-object-coercible.js":function(e){e.exports=function(e){if(null==e)throw TypeError("Can't call method on "+e);return e}},"./node_modules/core-js-pure/internals/set-global.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/global.js"),o=r("./node_modules/core-js-pure/internals/create-non-enumerable-property.js");e.exports=function(e,t){try{o(n,e,t)}catch(r){n[e]=t}return t}},"./node_modules/core-js-pure/internals/set-species.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/get-built-in.js"),o=r("./node_modules/core-js-pure/internals/object-define-property.js"),s=r("./node_modules/core-js-pure/internals/well-known-symbol.js"),i=r("./node_modules/core-js-pure/internals/descriptors.js"),a=s("species");e.exports=function(e){var t=n(e),r=o.f;i&&t&&!t[a]&&r(t,a,{configurable:!0,get:function(){return this}})}},"./node_modules/core-js-pure/internals/set-to-string-tag.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/to-string-tag-support.js"),o=r("./node_modules/core-js-pure/internals/object-define-property.js").f,s=r("./node_modules/core-js-pure/internals/create-non-enumerable-property.js"),i=r("./node_modules/core-js-pure/internals/has.js"),a=r("./node_modules/core-js-pure/internals/object-to-string.js"),A=r("./node_modules/core-js-pure/internals/well-known-symbol.js")("toStringTag");e.exports=function(e,t,r,u){if(e){var c=r?e:e.prototype;i(c,A)||o(c,A,{configurable:!0,value:t}),u&&!n&&s(c,"toString",a)}}},"./node_modules/core-js-pure/internals/shared-key.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/shared.js"),o=r("./node_modules/core-js-pure/internals/uid.js"),s=n("keys");e.exports=function(e){return s[e]||(s[e]=o(e))}},"./node_modules/core-js-pure/internals/shared-store.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/global.js"),o=r("./node_modules/core-js-pure/internals/set-global.js"),s="__core-js_shared__",i=n[s]||o(s,{});e.exports=i},"./node_modules/core-js-pure/internals/shared.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/is-pure.js"),o=r("./node_modules/core-js-pure/internals/shared-store.js");(e.exports=function(e,t){return o[e]||(o[e]=void 0!==t?t:{})})("versions",[]).push({version:"3.15.2",mode:n?"pure":"global",copyright:"© 2021 Denis Pushkarev (zloirock.ru)"})},"./node_modules/core-js-pure/internals/species-constructor.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/an-object.js"),o=r("./node_modules/core-js-pure/internals/a-function.js"),s=r("./node_modules/core-js-pure/internals/well-known-symbol.js")("species");e.exports=function(e,t){var r,i=n(e).constructor;return void 0===i||null==(r=n(i)[s])?t:o(r)}},"./node_modules/core-js-pure/internals/string-multibyte.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/to-integer.js"),o=r("./node_modules/core-js-pure/internals/require-object-coercible.js"),s=function(e){return function(t,r){var s,i,a=String(o(t)),A=n(r),u=a.length;return A<0||A>=u?e?"":void 0:(s=a.charCodeAt(A))<55296||s>56319||A+1===u||(i=a.charCodeAt(A+1))<56320||i>57343?e?a.charAt(A):s:e?a.slice(A,A+2):i-56320+(s-55296<<10)+65536}};e.exports={codeAt:s(!1),charAt:s(!0)}},"./node_modules/core-js-pure/internals/string-trim-forced.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/fails.js"),o=r("./node_modules/core-js-pure/internals/whitespaces.js");e.exports=function(e){return n((function(){return!!o[e]()||"​᠎"!="​᠎"[e]()||o[e].name!==e}))}},"./node_modules/core-js-pure/internals/string-trim.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/require-object-coercible.js"),o="["+r("./node_modules/core-js-pure/internals/whitespaces.js")+"]",s=RegExp("^"+o+o+"*"),i=RegExp(o+o+"*$"),a=function(e){return function(t){var r=String(n(t));return 1&e&&(r=r.replace(s,"")),2&e&&(r=r.replace(i,"")),r}};e.exports={start:a(1),end:a(2),trim:a(3)}},"./node_modules/core-js-pure/internals/task.js":function(e,t,r){var n,o,s,i=r("./node_modules/core-js-pure/internals/global.js"),a=r("./node_modules/core-js-pure/internals/fails.js"),A=r("./node_modules/core-js-pure/internals/function-bind-context.js"),u=r("./node_modules/core-js-pure/internals/html.js"),c=r("./node_modules/core-js-pure/internals/document-create-element.js"),l=r("./node_modules/core-js-pure/internals/engine-is-ios.js"),d=r("./node_modules/core-js-pure/internals/engine-is-node.js"),f=i.location,h=i.setImmediate,p=i.clearImmediate,m=i.process,g=i.MessageChannel,y=i.Dispatch,v=0,w={},b=function(e){if(w.hasOwnProperty(e)){var t=w[e];delete w[e],t()}},B=function(e){return function(){b(e)}},j=function(e){b(e.data)},_=function(e){i.postMessage(e+"",f.protocol+"//"+f.host)};h&&p||(h=function(e){for(var t=[],r=1;arguments.length>r;)t.push(arguments[r++]);return w[++v]=function(){("function"==typeof e?e:Function(e)).apply(void 0,t)},n(v),v},p=function(e){delete w[e]},d?n=function(e){m.nextTick(B(e))}:y&&y.now?n=function(e){y.now(B(e))}:g&&!l?(s=(o=new g).port2,o.port1.onmessage=j,n=A(s.postMessage,s,1)):i.addEventListener&&"function"==typeof postMessage&&!i.importScripts&&f&&"file:"!==f.protocol&&!a(_)?(n=_,i.addEventListener("message",j,!1)):n="onreadystatechange"in c("script")?function(e){u.appendChild(c("script")).onreadystatechange=function(){u.removeChild(this),b(e)}}:function(e){setTimeout(B(e),0)}),e.exports={set:h,clear:p}},"./node_modules/core-js-pure/internals/to-absolute-index.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/to-integer.js"),o=Math.max,s=Math.min;e.exports=function(e,t){var r=n(e);return r<0?o(r+t,0):s(r,t)}},"./node_modules/core-js-pure/internals/to-indexed-object.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/indexed-object.js"),o=r("./node_modules/core-js-pure/internals/require-object-coercible.js");e.exports=function(e){return n(o(e))}},"./node_modules/core-js-pure/internals/to-integer.js":function(e){var t=Math.ceil,r=Math.floor;e.exports=function(e){return isNaN(e=+e)?0:(e>0?r:t)(e)}},"./node_modules/core-js-pure/internals/to-length.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/to-integer.js"),o=Math.min;e.exports=function(e){return e>0?o(n(e),9007199254740991):0}},"./node_modules/core-js-pure/internals/to-object.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/require-object-coercible.js");e.exports=function(e){return Object(n(e))}},"./node_modules/core-js-pure/internals/to-primitive.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/is-object.js");e.exports=function(e,t){if(!n(e))return e;var r,o;if(t&&"function"==typeof(r=e.toString)&&!n(o=r.call(e)))return o;if("function"==typeof(r=e.valueOf)&&!n(o=r.call(e)))return o;if(!t&&"function"==typeof(r=e.toString)&&!n(o=r.call(e)))return o;throw TypeError("Can't convert object to primitive value")}},"./node_modules/core-js-pure/internals/to-string-tag-support.js":function(e,t,r){var n={};n[r("./node_modules/core-js-pure/internals/well-known-symbol.js")("toStringTag")]="z",e.exports="[object z]"===String(n)},"./node_modules/core-js-pure/internals/uid.js":function(e){var t=0,r=Math.random();e.exports=function(e){return"Symbol("+String(void 0===e?"":e)+")_"+(++t+r).toString(36)}},"./node_modules/core-js-pure/internals/use-symbol-as-uid.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/native-symbol.js");e.exports=n&&!Symbol.sham&&"symbol"==typeof Symbol.iterator},"./node_modules/core-js-pure/internals/well-known-symbol-wrapped.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/well-known-symbol.js");t.f=n},"./node_modules/core-js-pure/internals/well-known-symbol.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/global.js"),o=r("./node_modules/core-js-pure/internals/shared.js"),s=r("./node_modules/core-js-pure/internals/has.js"),i=r("./node_modules/core-js-pure/internals/uid.js"),a=r("./node_modules/core-js-pure/internals/native-symbol.js"),A=r("./node_modules/core-js-pure/internals/use-symbol-as-uid.js"),u=o("wks"),c=n.Symbol,l=A?c:c&&c.withoutSetter||i;e.exports=function(e){return s(u,e)&&(a||"string"==typeof u[e])||(a&&s(c,e)?u[e]=c[e]:u[e]=l("Symbol."+e)),u[e]}},"./node_modules/core-js-pure/internals/whitespaces.js":function(e){e.exports="\t\n\v\f\r                　\u2028\u2029\ufeff"},"./node_modules/core-js-pure/modules/es.aggregate-error.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/object-get-prototype-of.js"),s=r("./node_modules/core-js-pure/internals/object-set-prototype-of.js"),i=r("./node_modules/core-js-pure/internals/object-create.js"),a=r("./node_modules/core-js-pure/internals/create-non-enumerable-property.js"),A=r("./node_modules/core-js-pure/internals/create-property-descriptor.js"),u=r("./node_modules/core-js-pure/internals/iterate.js"),c=function(e,t){var r=this;if(!(r instanceof c))return new c(e,t);s&&(r=s(new Error(void 0),o(r))),void 0!==t&&a(r,"message",String(t));var n=[];return u(e,n.push,{that:n}),a(r,"errors",n),r};c.prototype=i(Error.prototype,{constructor:A(5,c),message:A(5,""),name:A(5,"AggregateError")}),n({global:!0},{AggregateError:c})},"./node_modules/core-js-pure/modules/es.array.concat.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/fails.js"),s=r("./node_modules/core-js-pure/internals/is-array.js"),i=r("./node_modules/core-js-pure/internals/is-object.js"),a=r("./node_modules/core-js-pure/internals/to-object.js"),A=r("./node_modules/core-js-pure/internals/to-length.js"),u=r("./node_modules/core-js-pure/internals/create-property.js"),c=r("./node_modules/core-js-pure/internals/array-species-create.js"),l=r("./node_modules/core-js-pure/internals/array-method-has-species-support.js"),d=r("./node_modules/core-js-pure/internals/well-known-symbol.js"),f=r("./node_modules/core-js-pure/internals/engine-v8-version.js"),h=d("isConcatSpreadable"),p=9007199254740991,m="Maximum allowed index exceeded",g=f>=51||!o((function(){var e=[];return e[h]=!1,e.concat()[0]!==e})),y=l("concat"),v=function(e){if(!i(e))return!1;var t=e[h];return void 0!==t?!!t:s(e)};n({target:"Array",proto:!0,forced:!g||!y},{concat:function(e){var t,r,n,o,s,i=a(this),l=c(i,0),d=0;for(t=-1,n=arguments.length;t<n;t++)if(v(s=-1===t?i:arguments[t])){if(d+(o=A(s.length))>p)throw TypeError(m);for(r=0;r<o;r++,d++)r in s&&u(l,d,s[r])}else{if(d>=p)throw TypeError(m);u(l,d++,s)}return l.length=d,l}})},"./node_modules/core-js-pure/modules/es.array.every.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/array-iteration.js").every;n({target:"Array",proto:!0,forced:!r("./node_modules/core-js-pure/internals/array-method-is-strict.js")("every")},{every:function(e){return o(this,e,arguments.length>1?arguments[1]:void 0)}})},"./node_modules/core-js-pure/modules/es.array.fill.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/array-fill.js"),s=r("./node_modules/core-js-pure/internals/add-to-unscopables.js");n({target:"Array",proto:!0},{fill:o}),s("fill")},"./node_modules/core-js-pure/modules/es.array.filter.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/array-iteration.js").filter;n({target:"Array",proto:!0,forced:!r("./node_modules/core-js-pure/internals/array-method-has-species-support.js")("filter")},{filter:function(e){return o(this,e,arguments.length>1?arguments[1]:void 0)}})},"./node_modules/core-js-pure/modules/es.array.for-each.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/array-for-each.js");n({target:"Array",proto:!0,forced:[].forEach!=o},{forEach:o})},"./node_modules/core-js-pure/modules/es.array.from.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/array-from.js");n({target:"Array",stat:!0,forced:!r("./node_modules/core-js-pure/internals/check-correctness-of-iteration.js")((function(e){Array.from(e)}))},{from:o})},"./node_modules/core-js-pure/modules/es.array.includes.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/array-includes.js").includes,s=r("./node_modules/core-js-pure/internals/add-to-unscopables.js");n({target:"Array",proto:!0},{includes:function(e){return o(this,e,arguments.length>1?arguments[1]:void 0)}}),s("includes")},"./node_modules/core-js-pure/modules/es.array.index-of.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/array-includes.js").indexOf,s=r("./node_modules/core-js-pure/internals/array-method-is-strict.js"),i=[].indexOf,a=!!i&&1/[1].indexOf(1,-0)<0,A=s("indexOf");n({target:"Array",proto:!0,forced:a||!A},{indexOf:function(e){return a?i.apply(this,arguments)||0:o(this,e,arguments.length>1?arguments[1]:void 0)}})},"./node_modules/core-js-pure/modules/es.array.is-array.js":function(e,t,r){r("./node_modules/core-js-pure/internals/export.js")({target:"Array",stat:!0},{isArray:r("./node_modules/core-js-pure/internals/is-array.js")})},"./node_modules/core-js-pure/modules/es.array.iterator.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/to-indexed-object.js"),o=r("./node_modules/core-js-pure/internals/add-to-unscopables.js"),s=r("./node_modules/core-js-pure/internals/iterators.js"),i=r("./node_modules/core-js-pure/internals/internal-state.js"),a=r("./node_modules/core-js-pure/internals/define-iterator.js"),A="Array Iterator",u=i.set,c=i.getterFor(A);e.exports=a(Array,"Array",(function(e,t){u(this,{type:A,target:n(e),index:0,kind:t})}),(function(){var e=c(this),t=e.target,r=e.kind,n=e.index++;return!t||n>=t.length?(e.target=void 0,{value:void 0,done:!0}):"keys"==r?{value:n,done:!1}:"values"==r?{value:t[n],done:!1}:{value:[n,t[n]],done:!1}}),"values"),s.Arguments=s.Array,o("keys"),o("values"),o("entries")},"./node_modules/core-js-pure/modules/es.array.map.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/array-iteration.js").map;n({target:"Array",proto:!0,forced:!r("./node_modules/core-js-pure/internals/array-method-has-species-support.js")("map")},{map:function(e){return o(this,e,arguments.length>1?arguments[1]:void 0)}})},"./node_modules/core-js-pure/modules/es.array.reduce.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/array-reduce.js").left,s=r("./node_modules/core-js-pure/internals/array-method-is-strict.js"),i=r("./node_modules/core-js-pure/internals/engine-v8-version.js"),a=r("./node_modules/core-js-pure/internals/engine-is-node.js");n({target:"Array",proto:!0,forced:!s("reduce")||!a&&i>79&&i<83},{reduce:function(e){return o(this,e,arguments.length,arguments.length>1?arguments[1]:void 0)}})},"./node_modules/core-js-pure/modules/es.array.reverse.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/is-array.js"),s=[].reverse,i=[1,2];n({target:"Array",proto:!0,forced:String(i)===String(i.reverse())},{reverse:function(){return o(this)&&(this.length=this.length),s.call(this)}})},"./node_modules/core-js-pure/modules/es.array.slice.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/is-object.js"),s=r("./node_modules/core-js-pure/internals/is-array.js"),i=r("./node_modules/core-js-pure/internals/to-absolute-index.js"),a=r("./node_modules/core-js-pure/internals/to-length.js"),A=r("./node_modules/core-js-pure/internals/to-indexed-object.js"),u=r("./node_modules/core-js-pure/internals/create-property.js"),c=r("./node_modules/core-js-pure/internals/well-known-symbol.js"),l=r("./node_modules/core-js-pure/internals/array-method-has-species-support.js")("slice"),d=c("species"),f=[].slice,h=Math.max;n({target:"Array",proto:!0,forced:!l},{slice:function(e,t){var r,n,c,l=A(this),p=a(l.length),m=i(e,p),g=i(void 0===t?p:t,p);if(s(l)&&("function"!=typeof(r=l.constructor)||r!==Array&&!s(r.prototype)?o(r)&&null===(r=r[d])&&(r=void 0):r=void 0,r===Array||void 0===r))return f.call(l,m,g);for(n=new(void 0===r?Array:r)(h(g-m,0)),c=0;m<g;m++,c++)m in l&&u(n,c,l[m]);return n.length=c,n}})},"./node_modules/core-js-pure/modules/es.array.some.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/array-iteration.js").some;n({target:"Array",proto:!0,forced:!r("./node_modules/core-js-pure/internals/array-method-is-strict.js")("some")},{some:function(e){return o(this,e,arguments.length>1?arguments[1]:void 0)}})},"./node_modules/core-js-pure/modules/es.date.now.js":function(e,t,r){r("./node_modules/core-js-pure/internals/export.js")({target:"Date",stat:!0},{now:function(){return(new Date).getTime()}})},"./node_modules/core-js-pure/modules/es.function.bind.js":function(e,t,r){r("./node_modules/core-js-pure/internals/export.js")({target:"Function",proto:!0},{bind:r("./node_modules/core-js-pure/internals/function-bind.js")})},"./node_modules/core-js-pure/modules/es.json.to-string-tag.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/global.js");r("./node_modules/core-js-pure/internals/set-to-string-tag.js")(n.JSON,"JSON",!0)},"./node_modules/core-js-pure/modules/es.map.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/collection.js"),o=r("./node_modules/core-js-pure/internals/collection-strong.js");e.exports=n("Map",(function(e){return function(){return e(this,arguments.length?arguments[0]:void 0)}}),o)},"./node_modules/core-js-pure/modules/es.math.to-string-tag.js":function(){},"./node_modules/core-js-pure/modules/es.object.create.js":function(e,t,r){r("./node_modules/core-js-pure/internals/export.js")({target:"Object",stat:!0,sham:!r("./node_modules/core-js-pure/internals/descriptors.js")},{create:r("./node_modules/core-js-pure/internals/object-create.js")})},"./node_modules/core-js-pure/modules/es.object.define-properties.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/descriptors.js");n({target:"Object",stat:!0,forced:!o,sham:!o},{defineProperties:r("./node_modules/core-js-pure/internals/object-define-properties.js")})},"./node_modules/core-js-pure/modules/es.object.define-property.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/descriptors.js");n({target:"Object",stat:!0,forced:!o,sham:!o},{defineProperty:r("./node_modules/core-js-pure/internals/object-define-property.js").f})},"./node_modules/core-js-pure/modules/es.object.get-own-property-descriptor.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/fails.js"),s=r("./node_modules/core-js-pure/internals/to-indexed-object.js"),i=r("./node_modules/core-js-pure/internals/object-get-own-property-descriptor.js").f,a=r("./node_modules/core-js-pure/internals/descriptors.js"),A=o((function(){i(1)}));n({target:"Object",stat:!0,forced:!a||A,sham:!a},{getOwnPropertyDescriptor:function(e,t){return i(s(e),t)}})},"./node_modules/core-js-pure/modules/es.object.get-own-property-descriptors.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/descriptors.js"),s=r("./node_modules/core-js-pure/internals/own-keys.js"),i=r("./node_modules/core-js-pure/internals/to-indexed-object.js"),a=r("./node_modules/core-js-pure/internals/object-get-own-property-descriptor.js"),A=r("./node_modules/core-js-pure/internals/create-property.js");n({target:"Object",stat:!0,sham:!o},{getOwnPropertyDescriptors:function(e){for(var t,r,n=i(e),o=a.f,u=s(n),c={},l=0;u.length>l;)void 0!==(r=o(n,t=u[l++]))&&A(c,t,r);return c}})},"./node_modules/core-js-pure/modules/es.object.get-prototype-of.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/fails.js"),s=r("./node_modules/core-js-pure/internals/to-object.js"),i=r("./node_modules/core-js-pure/internals/object-get-prototype-of.js"),a=r("./node_modules/core-js-pure/internals/correct-prototype-getter.js");n({target:"Object",stat:!0,forced:o((function(){i(1)})),sham:!a},{getPrototypeOf:function(e){return i(s(e))}})},"./node_modules/core-js-pure/modules/es.object.keys.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/to-object.js"),s=r("./node_modules/core-js-pure/internals/object-keys.js");n({target:"Object",stat:!0,forced:r("./node_modules/core-js-pure/internals/fails.js")((function(){s(1)}))},{keys:function(e){return s(o(e))}})},"./node_modules/core-js-pure/modules/es.object.set-prototype-of.js":function(e,t,r){r("./node_modules/core-js-pure/internals/export.js")({target:"Object",stat:!0},{setPrototypeOf:r("./node_modules/core-js-pure/internals/object-set-prototype-of.js")})},"./node_modules/core-js-pure/modules/es.object.to-string.js":function(){},"./node_modules/core-js-pure/modules/es.parse-float.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/number-parse-float.js");n({global:!0,forced:parseFloat!=o},{parseFloat:o})},"./node_modules/core-js-pure/modules/es.parse-int.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/number-parse-int.js");n({global:!0,forced:parseInt!=o},{parseInt:o})},"./node_modules/core-js-pure/modules/es.promise.all-settled.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/a-function.js"),s=r("./node_modules/core-js-pure/internals/new-promise-capability.js"),i=r("./node_modules/core-js-pure/internals/perform.js"),a=r("./node_modules/core-js-pure/internals/iterate.js");n({target:"Promise",stat:!0},{allSettled:function(e){var t=this,r=s.f(t),n=r.resolve,A=r.reject,u=i((function(){var r=o(t.resolve),s=[],i=0,A=1;a(e,(function(e){var o=i++,a=!1;s.push(void 0),A++,r.call(t,e).then((function(e){a||(a=!0,s[o]={status:"fulfilled",value:e},--A||n(s))}),(function(e){a||(a=!0,s[o]={status:"rejected",reason:e},--A||n(s))}))})),--A||n(s)}));return u.error&&A(u.value),r.promise}})},"./node_modules/core-js-pure/modules/es.promise.any.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/a-function.js"),s=r("./node_modules/core-js-pure/internals/get-built-in.js"),i=r("./node_modules/core-js-pure/internals/new-promise-capability.js"),a=r("./node_modules/core-js-pure/internals/perform.js"),A=r("./node_modules/core-js-pure/internals/iterate.js"),u="No one promise resolved";n({target:"Promise",stat:!0},{any:function(e){var t=this,r=i.f(t),n=r.resolve,c=r.reject,l=a((function(){var r=o(t.resolve),i=[],a=0,l=1,d=!1;A(e,(function(e){var o=a++,A=!1;i.push(void 0),l++,r.call(t,e).then((function(e){A||d||(d=!0,n(e))}),(function(e){A||d||(A=!0,i[o]=e,--l||c(new(s("AggregateError"))(i,u)))}))})),--l||c(new(s("AggregateError"))(i,u))}));return l.error&&c(l.value),r.promise}})},"./node_modules/core-js-pure/modules/es.promise.finally.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/is-pure.js"),s=r("./node_modules/core-js-pure/internals/native-promise-constructor.js"),i=r("./node_modules/core-js-pure/internals/fails.js"),a=r("./node_modules/core-js-pure/internals/get-built-in.js"),A=r("./node_modules/core-js-pure/internals/species-constructor.js"),u=r("./node_modules/core-js-pure/internals/promise-resolve.js"),c=r("./node_modules/core-js-pure/internals/redefine.js");if(n({target:"Promise",proto:!0,real:!0,forced:!!s&&i((function(){s.prototype.finally.call({then:function(){}},(function(){}))}))},{finally:function(e){var t=A(this,a("Promise")),r="function"==typeof e;return this.then(r?function(r){return u(t,e()).then((function(){return r}))}:e,r?function(r){return u(t,e()).then((function(){throw r}))}:e)}}),!o&&"function"==typeof s){var l=a("Promise").prototype.finally;s.prototype.finally!==l&&c(s.prototype,"finally",l,{unsafe:!0})}},"./node_modules/core-js-pure/modules/es.promise.js":function(e,t,r){"use strict";var n,o,s,i,a=r("./node_modules/core-js-pure/internals/export.js"),A=r("./node_modules/core-js-pure/internals/is-pure.js"),u=r("./node_modules/core-js-pure/internals/global.js"),c=r("./node_modules/core-js-pure/internals/get-built-in.js"),l=r("./node_modules/core-js-pure/internals/native-promise-constructor.js"),d=r("./node_modules/core-js-pure/internals/redefine.js"),f=r("./node_modules/core-js-pure/internals/redefine-all.js"),h=r("./node_modules/core-js-pure/internals/object-set-prototype-of.js"),p=r("./node_modules/core-js-pure/internals/set-to-string-tag.js"),m=r("./node_modules/core-js-pure/internals/set-species.js"),g=r("./node_modules/core-js-pure/internals/is-object.js"),y=r("./node_modules/core-js-pure/internals/a-function.js"),v=r("./node_modules/core-js-pure/internals/an-instance.js"),w=r("./node_modules/core-js-pure/internals/inspect-source.js"),b=r("./node_modules/core-js-pure/internals/iterate.js"),B=r("./node_modules/core-js-pure/internals/check-correctness-of-iteration.js"),j=r("./node_modules/core-js-pure/internals/species-constructor.js"),_=r("./node_modules/core-js-pure/internals/task.js").set,C=r("./node_modules/core-js-pure/internals/microtask.js"),x=r("./node_modules/core-js-pure/internals/promise-resolve.js"),E=r("./node_modules/core-js-pure/internals/host-report-errors.js"),N=r("./node_modules/core-js-pure/internals/new-promise-capability.js"),Q=r("./node_modules/core-js-pure/internals/perform.js"),F=r("./node_modules/core-js-pure/internals/internal-state.js"),U=r("./node_modules/core-js-pure/internals/is-forced.js"),S=r("./node_modules/core-js-pure/internals/well-known-symbol.js"),L=r("./node_modules/core-js-pure/internals/engine-is-browser.js"),T=r("./node_modules/core-js-pure/internals/engine-is-node.js"),H=r("./node_modules/core-js-pure/internals/engine-v8-version.js"),I=S("species"),P="Promise",O=F.get,k=F.set,R=F.getterFor(P),M=l&&l.prototype,D=l,K=M,z=u.TypeError,V=u.document,q=u.process,G=N.f,X=G,W=!!(V&&V.createEvent&&u.dispatchEvent),J="function"==typeof PromiseRejectionEvent,Y="unhandledrejection",Z=!1,$=U(P,(function(){var e=w(D),t=e!==String(D);if(!t&&66===H)return!0;if(A&&!K.finally)return!0;if(H>=51&&/native code/.test(e))return!1;var r=new D((function(e){e(1)})),n=function(e){e((function(){}),(function(){}))};return(r.constructor={})[I]=n,!(Z=r.then((function(){}))instanceof n)||!t&&L&&!J})),ee=$||!B((function(e){D.all(e).catch((function(){}))})),te=function(e){var t;return!(!g(e)||"function"!=typeof(t=e.then))&&t},re=function(e,t){if(!e.notified){e.notified=!0;var r=e.reactions;C((function(){for(var n=e.value,o=1==e.state,s=0;r.length>s;){var i,a,A,u=r[s++],c=o?u.ok:u.fail,l=u.resolve,d=u.reject,f=u.domain;try{c?(o||(2===e.rejection&&ie(e),e.rejection=1),!0===c?i=n:(f&&f.enter(),i=c(n),f&&(f.exit(),A=!0)),i===u.promise?d(z("Promise-chain cycle")):(a=te(i))?a.call(i,l,d):l(i)):d(n)}catch(e){f&&!A&&f.exit(),d(e)}}e.reactions=[],e.notified=!1,t&&!e.rejection&&oe(e)}))}},ne=function(e,t,r){var n,o;W?((n=V.createEvent("Event")).promise=t,n.reason=r,n.initEvent(e,!1,!0),u.dispatchEvent(n)):n={promise:t,reason:r},!J&&(o=u["on"+e])?o(n):e===Y&&E("Unhandled promise rejection",r)},oe=function(e){_.call(u,(function(){var t,r=e.facade,n=e.value;if(se(e)&&(t=Q((function(){T?q.emit("unhandledRejection",n,r):ne(Y,r,n)})),e.rejection=T||se(e)?2:1,t.error))throw t.value}))},se=function(e){return 1!==e.rejection&&!e.parent},ie=function(e){_.call(u,(function(){var t=e.facade;T?q.emit("rejectionHandled",t):ne("rejectionhandled",t,e.value)}))},ae=function(e,t,r){return function(n){e(t,n,r)}},Ae=function(e,t,r){e.done||(e.done=!0,r&&(e=r),e.value=t,e.state=2,re(e,!0))},ue=function(e,t,r){if(!e.done){e.done=!0,r&&(e=r);try{if(e.facade===t)throw z("Promise can't be resolved itself");var n=te(t);n?C((function(){var r={done:!1};try{n.call(t,ae(ue,r,e),ae(Ae,r,e))}catch(t){Ae(r,t,e)}})):(e.value=t,e.state=1,re(e,!1))}catch(t){Ae({done:!1},t,e)}}};if($&&(K=(D=function(e){v(this,D,P),y(e),n.call(this);var t=O(this);try{e(ae(ue,t),ae(Ae,t))}catch(e){Ae(t,e)}}).prototype,(n=function(e){k(this,{type:P,done:!1,notified:!1,parent:!1,reactions:[],rejection:!1,state:0,value:void 0})}).prototype=f(K,{then:function(e,t){var r=R(this),n=G(j(this,D));return n.ok="function"!=typeof e||e,n.fail="function"==typeof t&&t,n.domain=T?q.domain:void 0,r.parent=!0,r.reactions.push(n),0!=r.state&&re(r,!1),n.promise},catch:function(e){return this.then(void 0,e)}}),o=function(){var e=new n,t=O(e);this.promise=e,this.resolve=ae(ue,t),this.reject=ae(Ae,t)},N.f=G=function(e){return e===D||e===s?new o(e):X(e)},!A&&"function"==typeof l&&M!==Object.prototype)){i=M.then,Z||(d(M,"then",(function(e,t){var r=this;return new D((function(e,t){i.call(r,e,t)})).then(e,t)}),{unsafe:!0}),d(M,"catch",K.catch,{unsafe:!0}));try{delete M.constructor}catch(e){}h&&h(M,K)}a({global:!0,wrap:!0,forced:$},{Promise:D}),p(D,P,!1,!0),m(P),s=c(P),a({target:P,stat:!0,forced:$},{reject:function(e){var t=G(this);return t.reject.call(void 0,e),t.promise}}),a({target:P,stat:!0,forced:A||$},{resolve:function(e){return x(A&&this===s?D:this,e)}}),a({target:P,stat:!0,forced:ee},{all:function(e){var t=this,r=G(t),n=r.resolve,o=r.reject,s=Q((function(){var r=y(t.resolve),s=[],i=0,a=1;b(e,(function(e){var A=i++,u=!1;s.push(void 0),a++,r.call(t,e).then((function(e){u||(u=!0,s[A]=e,--a||n(s))}),o)})),--a||n(s)}));return s.error&&o(s.value),r.promise},race:function(e){var t=this,r=G(t),n=r.reject,o=Q((function(){var o=y(t.resolve);b(e,(function(e){o.call(t,e).then(r.resolve,n)}))}));return o.error&&n(o.value),r.promise}})},"./node_modules/core-js-pure/modules/es.reflect.apply.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/get-built-in.js"),s=r("./node_modules/core-js-pure/internals/a-function.js"),i=r("./node_modules/core-js-pure/internals/an-object.js"),a=r("./node_modules/core-js-pure/internals/fails.js"),A=o("Reflect","apply"),u=Function.apply;n({target:"Reflect",stat:!0,forced:!a((function(){A((function(){}))}))},{apply:function(e,t,r){return s(e),i(r),A?A(e,t,r):u.call(e,t,r)}})},"./node_modules/core-js-pure/modules/es.reflect.construct.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/get-built-in.js"),s=r("./node_modules/core-js-pure/internals/a-function.js"),i=r("./node_modules/core-js-pure/internals/an-object.js"),a=r("./node_modules/core-js-pure/internals/is-object.js"),A=r("./node_modules/core-js-pure/internals/object-create.js"),u=r("./node_modules/core-js-pure/internals/function-bind.js"),c=r("./node_modules/core-js-pure/internals/fails.js"),l=o("Reflect","construct"),d=c((function(){function e(){}return!(l((function(){}),[],e)instanceof e)})),f=!c((function(){l((function(){}))})),h=d||f;n({target:"Reflect",stat:!0,forced:h,sham:h},{construct:function(e,t){s(e),i(t);var r=arguments.length<3?e:s(arguments[2]);if(f&&!d)return l(e,t,r);if(e==r){switch(t.length){case 0:return new e;case 1:return new e(t[0]);case 2:return new e(t[0],t[1]);case 3:return new e(t[0],t[1],t[2]);case 4:return new e(t[0],t[1],t[2],t[3])}var n=[null];return n.push.apply(n,t),new(u.apply(e,n))}var o=r.prototype,c=A(a(o)?o:Object.prototype),h=Function.apply.call(e,c,t);return a(h)?h:c}})},"./node_modules/core-js-pure/modules/es.reflect.delete-property.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/an-object.js"),s=r("./node_modules/core-js-pure/internals/object-get-own-property-descriptor.js").f;n({target:"Reflect",stat:!0},{deleteProperty:function(e,t){var r=s(o(e),t);return!(r&&!r.configurable)&&delete e[t]}})},"./node_modules/core-js-pure/modules/es.reflect.get-prototype-of.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/an-object.js"),s=r("./node_modules/core-js-pure/internals/object-get-prototype-of.js");n({target:"Reflect",stat:!0,sham:!r("./node_modules/core-js-pure/internals/correct-prototype-getter.js")},{getPrototypeOf:function(e){return s(o(e))}})},"./node_modules/core-js-pure/modules/es.reflect.get.js":function(e,t,r){var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/is-object.js"),s=r("./node_modules/core-js-pure/internals/an-object.js"),i=r("./node_modules/core-js-pure/internals/has.js"),a=r("./node_modules/core-js-pure/internals/object-get-own-property-descriptor.js"),A=r("./node_modules/core-js-pure/internals/object-get-prototype-of.js");n({target:"Reflect",stat:!0},{get:function e(t,r){var n,u,c=arguments.length<3?t:arguments[2];return s(t)===c?t[r]:(n=a.f(t,r))?i(n,"value")?n.value:void 0===n.get?void 0:n.get.call(c):o(u=A(t))?e(u,r,c):void 0}})},"./node_modules/core-js-pure/modules/es.reflect.to-string-tag.js":function(){},"./node_modules/core-js-pure/modules/es.string.includes.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/not-a-regexp.js"),s=r("./node_modules/core-js-pure/internals/require-object-coercible.js");n({target:"String",proto:!0,forced:!r("./node_modules/core-js-pure/internals/correct-is-regexp-logic.js")("includes")},{includes:function(e){return!!~String(s(this)).indexOf(o(e),arguments.length>1?arguments[1]:void 0)}})},"./node_modules/core-js-pure/modules/es.string.iterator.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/string-multibyte.js").charAt,o=r("./node_modules/core-js-pure/internals/internal-state.js"),s=r("./node_modules/core-js-pure/internals/define-iterator.js"),i="String Iterator",a=o.set,A=o.getterFor(i);s(String,"String",(function(e){a(this,{type:i,string:String(e),index:0})}),(function(){var e,t=A(this),r=t.string,o=t.index;return o>=r.length?{value:void 0,done:!0}:(e=n(r,o),t.index+=e.length,{value:e,done:!1})}))},"./node_modules/core-js-pure/modules/es.string.starts-with.js":function(e,t,r){"use strict";var n,o=r("./node_modules/core-js-pure/internals/export.js"),s=r("./node_modules/core-js-pure/internals/object-get-own-property-descriptor.js").f,i=r("./node_modules/core-js-pure/internals/to-length.js"),a=r("./node_modules/core-js-pure/internals/not-a-regexp.js"),A=r("./node_modules/core-js-pure/internals/require-object-coercible.js"),u=r("./node_modules/core-js-pure/internals/correct-is-regexp-logic.js"),c=r("./node_modules/core-js-pure/internals/is-pure.js"),l="".startsWith,d=Math.min,f=u("startsWith");o({target:"String",proto:!0,forced:!(!c&&!f&&(n=s(String.prototype,"startsWith"),n&&!n.writable)||f)},{startsWith:function(e){var t=String(A(this));a(e);var r=i(d(arguments.length>1?arguments[1]:void 0,t.length)),n=String(e);return l?l.call(t,n,r):t.slice(r,r+n.length)===n}})},"./node_modules/core-js-pure/modules/es.string.trim.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/string-trim.js").trim;n({target:"String",proto:!0,forced:r("./node_modules/core-js-pure/internals/string-trim-forced.js")("trim")},{trim:function(){return o(this)}})},"./node_modules/core-js-pure/modules/es.symbol.async-iterator.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("asyncIterator")},"./node_modules/core-js-pure/modules/es.symbol.description.js":function(){},"./node_modules/core-js-pure/modules/es.symbol.has-instance.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("hasInstance")},"./node_modules/core-js-pure/modules/es.symbol.is-concat-spreadable.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("isConcatSpreadable")},"./node_modules/core-js-pure/modules/es.symbol.iterator.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("iterator")},"./node_modules/core-js-pure/modules/es.symbol.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/global.js"),s=r("./node_modules/core-js-pure/internals/get-built-in.js"),i=r("./node_modules/core-js-pure/internals/is-pure.js"),a=r("./node_modules/core-js-pure/internals/descriptors.js"),A=r("./node_modules/core-js-pure/internals/native-symbol.js"),u=r("./node_modules/core-js-pure/internals/use-symbol-as-uid.js"),c=r("./node_modules/core-js-pure/internals/fails.js"),l=r("./node_modules/core-js-pure/internals/has.js"),d=r("./node_modules/core-js-pure/internals/is-array.js"),f=r("./node_modules/core-js-pure/internals/is-object.js"),h=r("./node_modules/core-js-pure/internals/an-object.js"),p=r("./node_modules/core-js-pure/internals/to-object.js"),m=r("./node_modules/core-js-pure/internals/to-indexed-object.js"),g=r("./node_modules/core-js-pure/internals/to-primitive.js"),y=r("./node_modules/core-js-pure/internals/create-property-descriptor.js"),v=r("./node_modules/core-js-pure/internals/object-create.js"),w=r("./node_modules/core-js-pure/internals/object-keys.js"),b=r("./node_modules/core-js-pure/internals/object-get-own-property-names.js"),B=r("./node_modules/core-js-pure/internals/object-get-own-property-names-external.js"),j=r("./node_modules/core-js-pure/internals/object-get-own-property-symbols.js"),_=r("./node_modules/core-js-pure/internals/object-get-own-property-descriptor.js"),C=r("./node_modules/core-js-pure/internals/object-define-property.js"),x=r("./node_modules/core-js-pure/internals/object-property-is-enumerable.js"),E=r("./node_modules/core-js-pure/internals/create-non-enumerable-property.js"),N=r("./node_modules/core-js-pure/internals/redefine.js"),Q=r("./node_modules/core-js-pure/internals/shared.js"),F=r("./node_modules/core-js-pure/internals/shared-key.js"),U=r("./node_modules/core-js-pure/internals/hidden-keys.js"),S=r("./node_modules/core-js-pure/internals/uid.js"),L=r("./node_modules/core-js-pure/internals/well-known-symbol.js"),T=r("./node_modules/core-js-pure/internals/well-known-symbol-wrapped.js"),H=r("./node_modules/core-js-pure/internals/define-well-known-symbol.js"),I=r("./node_modules/core-js-pure/internals/set-to-string-tag.js"),P=r("./node_modules/core-js-pure/internals/internal-state.js"),O=r("./node_modules/core-js-pure/internals/array-iteration.js").forEach,k=F("hidden"),R="Symbol",M=L("toPrimitive"),D=P.set,K=P.getterFor(R),z=Object.prototype,V=o.Symbol,q=s("JSON","stringify"),G=_.f,X=C.f,W=B.f,J=x.f,Y=Q("symbols"),Z=Q("op-symbols"),$=Q("string-to-symbol-registry"),ee=Q("symbol-to-string-registry"),te=Q("wks"),re=o.QObject,ne=!re||!re.prototype||!re.prototype.findChild,oe=a&&c((function(){return 7!=v(X({},"a",{get:function(){return X(this,"a",{value:7}).a}})).a}))?function(e,t,r){var n=G(z,t);n&&delete z[t],X(e,t,r),n&&e!==z&&X(z,t,n)}:X,se=function(e,t){var r=Y[e]=v(V.prototype);return D(r,{type:R,tag:e,description:t}),a||(r.description=t),r},ie=u?function(e){return"symbol"==typeof e}:function(e){return Object(e)instanceof V},ae=function(e,t,r){e===z&&ae(Z,t,r),h(e);var n=g(t,!0);return h(r),l(Y,n)?(r.enumerable?(l(e,k)&&e[k][n]&&(e[k][n]=!1),r=v(r,{enumerable:y(0,!1)})):(l(e,k)||X(e,k,y(1,{})),e[k][n]=!0),oe(e,n,r)):X(e,n,r)},Ae=function(e,t){h(e);var r=m(t),n=w(r).concat(de(r));return O(n,(function(t){a&&!ue.call(r,t)||ae(e,t,r[t])})),e},ue=function(e){var t=g(e,!0),r=J.call(this,t);return!(this===z&&l(Y,t)&&!l(Z,t))&&(!(r||!l(this,t)||!l(Y,t)||l(this,k)&&this[k][t])||r)},ce=function(e,t){var r=m(e),n=g(t,!0);if(r!==z||!l(Y,n)||l(Z,n)){var o=G(r,n);return!o||!l(Y,n)||l(r,k)&&r[k][n]||(o.enumerable=!0),o}},le=function(e){var t=W(m(e)),r=[];return O(t,(function(e){l(Y,e)||l(U,e)||r.push(e)})),r},de=function(e){var t=e===z,r=W(t?Z:m(e)),n=[];return O(r,(function(e){!l(Y,e)||t&&!l(z,e)||n.push(Y[e])})),n};A||(N((V=function(){if(this instanceof V)throw TypeError("Symbol is not a constructor");var e=arguments.length&&void 0!==arguments[0]?String(arguments[0]):void 0,t=S(e),r=function(e){this===z&&r.call(Z,e),l(this,k)&&l(this[k],t)&&(this[k][t]=!1),oe(this,t,y(1,e))};return a&&ne&&oe(z,t,{configurable:!0,set:r}),se(t,e)}).prototype,"toString",(function(){return K(this).tag})),N(V,"withoutSetter",(function(e){return se(S(e),e)})),x.f=ue,C.f=ae,_.f=ce,b.f=B.f=le,j.f=de,T.f=function(e){return se(L(e),e)},a&&(X(V.prototype,"description",{configurable:!0,get:function(){return K(this).description}}),i||N(z,"propertyIsEnumerable",ue,{unsafe:!0}))),n({global:!0,wrap:!0,forced:!A,sham:!A},{Symbol:V}),O(w(te),(function(e){H(e)})),n({target:R,stat:!0,forced:!A},{for:function(e){var t=String(e);if(l($,t))return $[t];var r=V(t);return $[t]=r,ee[r]=t,r},keyFor:function(e){if(!ie(e))throw TypeError(e+" is not a symbol");if(l(ee,e))return ee[e]},useSetter:function(){ne=!0},useSimple:function(){ne=!1}}),n({target:"Object",stat:!0,forced:!A,sham:!a},{create:function(e,t){return void 0===t?v(e):Ae(v(e),t)},defineProperty:ae,defineProperties:Ae,getOwnPropertyDescriptor:ce}),n({target:"Object",stat:!0,forced:!A},{getOwnPropertyNames:le,getOwnPropertySymbols:de}),n({target:"Object",stat:!0,forced:c((function(){j.f(1)}))},{getOwnPropertySymbols:function(e){return j.f(p(e))}}),q&&n({target:"JSON",stat:!0,forced:!A||c((function(){var e=V();return"[null]"!=q([e])||"{}"!=q({a:e})||"{}"!=q(Object(e))}))},{stringify:function(e,t,r){for(var n,o=[e],s=1;arguments.length>s;)o.push(arguments[s++]);if(n=t,(f(t)||void 0!==e)&&!ie(e))return d(t)||(t=function(e,t){if("function"==typeof n&&(t=n.call(this,e,t)),!ie(t))return t}),o[1]=t,q.apply(null,o)}}),V.prototype[M]||E(V.prototype,M,V.prototype.valueOf),I(V,R),U[k]=!0},"./node_modules/core-js-pure/modules/es.symbol.match-all.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("matchAll")},"./node_modules/core-js-pure/modules/es.symbol.match.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("match")},"./node_modules/core-js-pure/modules/es.symbol.replace.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("replace")},"./node_modules/core-js-pure/modules/es.symbol.search.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("search")},"./node_modules/core-js-pure/modules/es.symbol.species.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("species")},"./node_modules/core-js-pure/modules/es.symbol.split.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("split")},"./node_modules/core-js-pure/modules/es.symbol.to-primitive.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("toPrimitive")},"./node_modules/core-js-pure/modules/es.symbol.to-string-tag.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("toStringTag")},"./node_modules/core-js-pure/modules/es.symbol.unscopables.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("unscopables")},"./node_modules/core-js-pure/modules/esnext.aggregate-error.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.aggregate-error.js")},"./node_modules/core-js-pure/modules/esnext.promise.all-settled.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.promise.all-settled.js")},"./node_modules/core-js-pure/modules/esnext.promise.any.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.promise.any.js")},"./node_modules/core-js-pure/modules/esnext.promise.try.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js-pure/internals/export.js"),o=r("./node_modules/core-js-pure/internals/new-promise-capability.js"),s=r("./node_modules/core-js-pure/internals/perform.js");n({target:"Promise",stat:!0},{try:function(e){var t=o.f(this),r=s(e);return(r.error?t.reject:t.resolve)(r.value),t.promise}})},"./node_modules/core-js-pure/modules/esnext.symbol.async-dispose.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("asyncDispose")},"./node_modules/core-js-pure/modules/esnext.symbol.dispose.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("dispose")},"./node_modules/core-js-pure/modules/esnext.symbol.matcher.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("matcher")},"./node_modules/core-js-pure/modules/esnext.symbol.metadata.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("metadata")},"./node_modules/core-js-pure/modules/esnext.symbol.observable.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("observable")},"./node_modules/core-js-pure/modules/esnext.symbol.pattern-match.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("patternMatch")},"./node_modules/core-js-pure/modules/esnext.symbol.replace-all.js":function(e,t,r){r("./node_modules/core-js-pure/internals/define-well-known-symbol.js")("replaceAll")},"./node_modules/core-js-pure/modules/web.dom-collections.iterator.js":function(e,t,r){r("./node_modules/core-js-pure/modules/es.array.iterator.js");var n=r("./node_modules/core-js-pure/internals/dom-iterables.js"),o=r("./node_modules/core-js-pure/internals/global.js"),s=r("./node_modules/core-js-pure/internals/classof.js"),i=r("./node_modules/core-js-pure/internals/create-non-enumerable-property.js"),a=r("./node_modules/core-js-pure/internals/iterators.js"),A=r("./node_modules/core-js-pure/internals/well-known-symbol.js")("toStringTag");for(var u in n){var c=o[u],l=c&&c.prototype;l&&s(l)!==A&&i(l,A,u),a[u]=a.Array}},"./node_modules/core-js-pure/stable/array/from.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/array/from.js");e.exports=n},"./node_modules/core-js-pure/stable/array/is-array.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/array/is-array.js");e.exports=n},"./node_modules/core-js-pure/stable/array/virtual/for-each.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/array/virtual/for-each.js");e.exports=n},"./node_modules/core-js-pure/stable/array/virtual/values.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/array/virtual/values.js");e.exports=n},"./node_modules/core-js-pure/stable/date/now.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/date/now.js");e.exports=n},"./node_modules/core-js-pure/stable/instance/bind.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/instance/bind.js");e.exports=n},"./node_modules/core-js-pure/stable/instance/concat.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/instance/concat.js");e.exports=n},"./node_modules/core-js-pure/stable/instance/every.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/instance/every.js");e.exports=n},"./node_modules/core-js-pure/stable/instance/fill.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/instance/fill.js");e.exports=n},"./node_modules/core-js-pure/stable/instance/filter.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/instance/filter.js");e.exports=n},"./node_modules/core-js-pure/stable/instance/for-each.js":function(e,t,r){r("./node_modules/core-js-pure/modules/web.dom-collections.iterator.js");var n=r("./node_modules/core-js-pure/stable/array/virtual/for-each.js"),o=r("./node_modules/core-js-pure/internals/classof.js"),s=Array.prototype,i={DOMTokenList:!0,NodeList:!0};e.exports=function(e){var t=e.forEach;return e===s||e instanceof Array&&t===s.forEach||i.hasOwnProperty(o(e))?n:t}},"./node_modules/core-js-pure/stable/instance/includes.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/instance/includes.js");e.exports=n},"./node_modules/core-js-pure/stable/instance/index-of.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/instance/index-of.js");e.exports=n},"./node_modules/core-js-pure/stable/instance/map.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/instance/map.js");e.exports=n},"./node_modules/core-js-pure/stable/instance/reduce.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/instance/reduce.js");e.exports=n},"./node_modules/core-js-pure/stable/instance/reverse.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/instance/reverse.js");e.exports=n},"./node_modules/core-js-pure/stable/instance/slice.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/instance/slice.js");e.exports=n},"./node_modules/core-js-pure/stable/instance/some.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/instance/some.js");e.exports=n},"./node_modules/core-js-pure/stable/instance/starts-with.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/instance/starts-with.js");e.exports=n},"./node_modules/core-js-pure/stable/instance/trim.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/instance/trim.js");e.exports=n},"./node_modules/core-js-pure/stable/instance/values.js":function(e,t,r){r("./node_modules/core-js-pure/modules/web.dom-collections.iterator.js");var n=r("./node_modules/core-js-pure/stable/array/virtual/values.js"),o=r("./node_modules/core-js-pure/internals/classof.js"),s=Array.prototype,i={DOMTokenList:!0,NodeList:!0};e.exports=function(e){var t=e.values;return e===s||e instanceof Array&&t===s.values||i.hasOwnProperty(o(e))?n:t}},"./node_modules/core-js-pure/stable/map/index.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/map/index.js");e.exports=n},"./node_modules/core-js-pure/stable/object/define-properties.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/object/define-properties.js");e.exports=n},"./node_modules/core-js-pure/stable/object/define-property.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/object/define-property.js");e.exports=n},"./node_modules/core-js-pure/stable/object/get-own-property-descriptor.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/object/get-own-property-descriptor.js");e.exports=n},"./node_modules/core-js-pure/stable/object/get-own-property-descriptors.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/object/get-own-property-descriptors.js");e.exports=n},"./node_modules/core-js-pure/stable/object/get-own-property-symbols.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/object/get-own-property-symbols.js");e.exports=n},"./node_modules/core-js-pure/stable/object/keys.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/object/keys.js");e.exports=n},"./node_modules/core-js-pure/stable/parse-float.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/parse-float.js");e.exports=n},"./node_modules/core-js-pure/stable/parse-int.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/parse-int.js");e.exports=n},"./node_modules/core-js-pure/stable/promise/index.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/promise/index.js");e.exports=n},"./node_modules/core-js-pure/stable/reflect/apply.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/reflect/apply.js");e.exports=n},"./node_modules/core-js-pure/stable/reflect/construct.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/reflect/construct.js");e.exports=n},"./node_modules/core-js-pure/stable/reflect/delete-property.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/reflect/delete-property.js");e.exports=n},"./node_modules/core-js-pure/stable/reflect/get-prototype-of.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/reflect/get-prototype-of.js");e.exports=n},"./node_modules/core-js-pure/stable/symbol/index.js":function(e,t,r){var n=r("./node_modules/core-js-pure/es/symbol/index.js");e.exports=n},"./node_modules/core-js/internals/a-function.js":function(e){e.exports=function(e){if("function"!=typeof e)throw TypeError(String(e)+" is not a function");return e}},"./node_modules/core-js/internals/a-possible-prototype.js":function(e,t,r){var n=r("./node_modules/core-js/internals/is-object.js");e.exports=function(e){if(!n(e)&&null!==e)throw TypeError("Can't set "+String(e)+" as a prototype");return e}},"./node_modules/core-js/internals/add-to-unscopables.js":function(e,t,r){var n=r("./node_modules/core-js/internals/well-known-symbol.js"),o=r("./node_modules/core-js/internals/object-create.js"),s=r("./node_modules/core-js/internals/object-define-property.js"),i=n("unscopables"),a=Array.prototype;null==a[i]&&s.f(a,i,{configurable:!0,value:o(null)}),e.exports=function(e){a[i][e]=!0}},"./node_modules/core-js/internals/an-object.js":function(e,t,r){var n=r("./node_modules/core-js/internals/is-object.js");e.exports=function(e){if(!n(e))throw TypeError(String(e)+" is not an object");return e}},"./node_modules/core-js/internals/array-for-each.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/array-iteration.js").forEach,o=r("./node_modules/core-js/internals/array-method-is-strict.js")("forEach");e.exports=o?[].forEach:function(e){return n(this,e,arguments.length>1?arguments[1]:void 0)}},"./node_modules/core-js/internals/array-includes.js":function(e,t,r){var n=r("./node_modules/core-js/internals/to-indexed-object.js"),o=r("./node_modules/core-js/internals/to-length.js"),s=r("./node_modules/core-js/internals/to-absolute-index.js"),i=function(e){return function(t,r,i){var a,A=n(t),u=o(A.length),c=s(i,u);if(e&&r!=r){for(;u>c;)if((a=A[c++])!=a)return!0}else for(;u>c;c++)if((e||c in A)&&A[c]===r)return e||c||0;return!e&&-1}};e.exports={includes:i(!0),indexOf:i(!1)}},"./node_modules/core-js/internals/array-iteration.js":function(e,t,r){var n=r("./node_modules/core-js/internals/function-bind-context.js"),o=r("./node_modules/core-js/internals/indexed-object.js"),s=r("./node_modules/core-js/internals/to-object.js"),i=r("./node_modules/core-js/internals/to-length.js"),a=r("./node_modules/core-js/internals/array-species-create.js"),A=[].push,u=function(e){var t=1==e,r=2==e,u=3==e,c=4==e,l=6==e,d=7==e,f=5==e||l;return function(h,p,m,g){for(var y,v,w=s(h),b=o(w),B=n(p,m,3),j=i(b.length),_=0,C=g||a,x=t?C(h,j):r||d?C(h,0):void 0;j>_;_++)if((f||_ in b)&&(v=B(y=b[_],_,w),e))if(t)x[_]=v;else if(v)switch(e){case 3:return!0;case 5:return y;case 6:return _;case 2:A.call(x,y)}else switch(e){case 4:return!1;case 7:A.call(x,y)}return l?-1:u||c?c:x}};e.exports={forEach:u(0),map:u(1),filter:u(2),some:u(3),every:u(4),find:u(5),findIndex:u(6),filterReject:u(7)}},"./node_modules/core-js/internals/array-method-has-species-support.js":function(e,t,r){var n=r("./node_modules/core-js/internals/fails.js"),o=r("./node_modules/core-js/internals/well-known-symbol.js"),s=r("./node_modules/core-js/internals/engine-v8-version.js"),i=o("species");e.exports=function(e){return s>=51||!n((function(){var t=[];return(t.constructor={})[i]=function(){return{foo:1}},1!==t[e](Boolean).foo}))}},"./node_modules/core-js/internals/array-method-is-strict.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/fails.js");e.exports=function(e,t){var r=[][e];return!!r&&n((function(){r.call(null,t||function(){throw 1},1)}))}},"./node_modules/core-js/internals/array-species-constructor.js":function(e,t,r){var n=r("./node_modules/core-js/internals/is-object.js"),o=r("./node_modules/core-js/internals/is-array.js"),s=r("./node_modules/core-js/internals/well-known-symbol.js")("species");e.exports=function(e){var t;return o(e)&&("function"!=typeof(t=e.constructor)||t!==Array&&!o(t.prototype)?n(t)&&null===(t=t[s])&&(t=void 0):t=void 0),void 0===t?Array:t}},"./node_modules/core-js/internals/array-species-create.js":function(e,t,r){var n=r("./node_modules/core-js/internals/array-species-constructor.js");e.exports=function(e,t){return new(n(e))(0===t?0:t)}},"./node_modules/core-js/internals/classof-raw.js":function(e){var t={}.toString;e.exports=function(e){return t.call(e).slice(8,-1)}},"./node_modules/core-js/internals/classof.js":function(e,t,r){var n=r("./node_modules/core-js/internals/to-string-tag-support.js"),o=r("./node_modules/core-js/internals/classof-raw.js"),s=r("./node_modules/core-js/internals/well-known-symbol.js")("toStringTag"),i="Arguments"==o(function(){return arguments}());e.exports=n?o:function(e){var t,r,n;return void 0===e?"Undefined":null===e?"Null":"string"==typeof(r=function(e,t){try{return e[t]}catch(e){}}(t=Object(e),s))?r:i?o(t):"Object"==(n=o(t))&&"function"==typeof t.callee?"Arguments":n}},"./node_modules/core-js/internals/copy-constructor-properties.js":function(e,t,r){var n=r("./node_modules/core-js/internals/has.js"),o=r("./node_modules/core-js/internals/own-keys.js"),s=r("./node_modules/core-js/internals/object-get-own-property-descriptor.js"),i=r("./node_modules/core-js/internals/object-define-property.js");e.exports=function(e,t){for(var r=o(t),a=i.f,A=s.f,u=0;u<r.length;u++){var c=r[u];n(e,c)||a(e,c,A(t,c))}}},"./node_modules/core-js/internals/correct-prototype-getter.js":function(e,t,r){var n=r("./node_modules/core-js/internals/fails.js");e.exports=!n((function(){function e(){}return e.prototype.constructor=null,Object.getPrototypeOf(new e)!==e.prototype}))},"./node_modules/core-js/internals/create-html.js":function(e,t,r){var n=r("./node_modules/core-js/internals/require-object-coercible.js"),o=r("./node_modules/core-js/internals/to-string.js"),s=/"/g;e.exports=function(e,t,r,i){var a=o(n(e)),A="<"+t;return""!==r&&(A+=" "+r+'="'+o(i).replace(s,"&quot;")+'"'),A+">"+a+"</"+t+">"}},"./node_modules/core-js/internals/create-iterator-constructor.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/iterators-core.js").IteratorPrototype,o=r("./node_modules/core-js/internals/object-create.js"),s=r("./node_modules/core-js/internals/create-property-descriptor.js"),i=r("./node_modules/core-js/internals/set-to-string-tag.js"),a=r("./node_modules/core-js/internals/iterators.js"),A=function(){return this};e.exports=function(e,t,r){var u=t+" Iterator";return e.prototype=o(n,{next:s(1,r)}),i(e,u,!1,!0),a[u]=A,e}},"./node_modules/core-js/internals/create-non-enumerable-property.js":function(e,t,r){var n=r("./node_modules/core-js/internals/descriptors.js"),o=r("./node_modules/core-js/internals/object-define-property.js"),s=r("./node_modules/core-js/internals/create-property-descriptor.js");e.exports=n?function(e,t,r){return o.f(e,t,s(1,r))}:function(e,t,r){return e[t]=r,e}},"./node_modules/core-js/internals/create-property-descriptor.js":function(e){e.exports=function(e,t){return{enumerable:!(1&e),configurable:!(2&e),writable:!(4&e),value:t}}},"./node_modules/core-js/internals/create-property.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/to-property-key.js"),o=r("./node_modules/core-js/internals/object-define-property.js"),s=r("./node_modules/core-js/internals/create-property-descriptor.js");e.exports=function(e,t,r){var i=n(t);i in e?o.f(e,i,s(0,r)):e[i]=r}},"./node_modules/core-js/internals/define-iterator.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/export.js"),o=r("./node_modules/core-js/internals/create-iterator-constructor.js"),s=r("./node_modules/core-js/internals/object-get-prototype-of.js"),i=r("./node_modules/core-js/internals/object-set-prototype-of.js"),a=r("./node_modules/core-js/internals/set-to-string-tag.js"),A=r("./node_modules/core-js/internals/create-non-enumerable-property.js"),u=r("./node_modules/core-js/internals/redefine.js"),c=r("./node_modules/core-js/internals/well-known-symbol.js"),l=r("./node_modules/core-js/internals/is-pure.js"),d=r("./node_modules/core-js/internals/iterators.js"),f=r("./node_modules/core-js/internals/iterators-core.js"),h=f.IteratorPrototype,p=f.BUGGY_SAFARI_ITERATORS,m=c("iterator"),g="keys",y="values",v="entries",w=function(){return this};e.exports=function(e,t,r,c,f,b,B){o(r,t,c);var j,_,C,x=function(e){if(e===f&&U)return U;if(!p&&e in Q)return Q[e];switch(e){case g:case y:case v:return function(){return new r(this,e)}}return function(){return new r(this)}},E=t+" Iterator",N=!1,Q=e.prototype,F=Q[m]||Q["@@iterator"]||f&&Q[f],U=!p&&F||x(f),S="Array"==t&&Q.entries||F;if(S&&(j=s(S.call(new e)),h!==Object.prototype&&j.next&&(l||s(j)===h||(i?i(j,h):"function"!=typeof j[m]&&A(j,m,w)),a(j,E,!0,!0),l&&(d[E]=w))),f==y&&F&&F.name!==y&&(N=!0,U=function(){return F.call(this)}),l&&!B||Q[m]===U||A(Q,m,U),d[t]=U,f)if(_={values:x(y),keys:b?U:x(g),entries:x(v)},B)for(C in _)(p||N||!(C in Q))&&u(Q,C,_[C]);else n({target:t,proto:!0,forced:p||N},_);return _}},"./node_modules/core-js/internals/define-well-known-symbol.js":function(e,t,r){var n=r("./node_modules/core-js/internals/path.js"),o=r("./node_modules/core-js/internals/has.js"),s=r("./node_modules/core-js/internals/well-known-symbol-wrapped.js"),i=r("./node_modules/core-js/internals/object-define-property.js").f;e.exports=function(e){var t=n.Symbol||(n.Symbol={});o(t,e)||i(t,e,{value:s.f(e)})}},"./node_modules/core-js/internals/descriptors.js":function(e,t,r){var n=r("./node_modules/core-js/internals/fails.js");e.exports=!n((function(){return 7!=Object.defineProperty({},1,{get:function(){return 7}})[1]}))},"./node_modules/core-js/internals/document-create-element.js":function(e,t,r){var n=r("./node_modules/core-js/internals/global.js"),o=r("./node_modules/core-js/internals/is-object.js"),s=n.document,i=o(s)&&o(s.createElement);e.exports=function(e){return i?s.createElement(e):{}}},"./node_modules/core-js/internals/dom-iterables.js":function(e){e.exports={CSSRuleList:0,CSSStyleDeclaration:0,CSSValueList:0,ClientRectList:0,DOMRectList:0,DOMStringList:0,DOMTokenList:1,DataTransferItemList:0,FileList:0,HTMLAllCollection:0,HTMLCollection:0,HTMLFormElement:0,HTMLSelectElement:0,MediaList:0,MimeTypeArray:0,NamedNodeMap:0,NodeList:1,PaintRequestList:0,Plugin:0,PluginArray:0,SVGLengthList:0,SVGNumberList:0,SVGPathSegList:0,SVGPointList:0,SVGStringList:0,SVGTransformList:0,SourceBufferList:0,StyleSheetList:0,TextTrackCueList:0,TextTrackList:0,TouchList:0}},"./node_modules/core-js/internals/engine-user-agent.js":function(e,t,r){var n=r("./node_modules/core-js/internals/get-built-in.js");e.exports=n("navigator","userAgent")||""},"./node_modules/core-js/internals/engine-v8-version.js":function(e,t,r){var n,o,s=r("./node_modules/core-js/internals/global.js"),i=r("./node_modules/core-js/internals/engine-user-agent.js"),a=s.process,A=s.Deno,u=a&&a.versions||A&&A.version,c=u&&u.v8;c?o=(n=c.split("."))[0]<4?1:n[0]+n[1]:i&&(!(n=i.match(/Edge\/(\d+)/))||n[1]>=74)&&(n=i.match(/Chrome\/(\d+)/))&&(o=n[1]),e.exports=o&&+o},"./node_modules/core-js/internals/enum-bug-keys.js":function(e){e.exports=["constructor","hasOwnProperty","isPrototypeOf","propertyIsEnumerable","toLocaleString","toString","valueOf"]},"./node_modules/core-js/internals/export.js":function(e,t,r){var n=r("./node_modules/core-js/internals/global.js"),o=r("./node_modules/core-js/internals/object-get-own-property-descriptor.js").f,s=r("./node_modules/core-js/internals/create-non-enumerable-property.js"),i=r("./node_modules/core-js/internals/redefine.js"),a=r("./node_modules/core-js/internals/set-global.js"),A=r("./node_modules/core-js/internals/copy-constructor-properties.js"),u=r("./node_modules/core-js/internals/is-forced.js");e.exports=function(e,t){var r,c,l,d,f,h=e.target,p=e.global,m=e.stat;if(r=p?n:m?n[h]||a(h,{}):(n[h]||{}).prototype)for(c in t){if(d=t[c],l=e.noTargetGet?(f=o(r,c))&&f.value:r[c],!u(p?c:h+(m?".":"#")+c,e.forced)&&void 0!==l){if(typeof d==typeof l)continue;A(d,l)}(e.sham||l&&l.sham)&&s(d,"sham",!0),i(r,c,d,e)}}},"./node_modules/core-js/internals/fails.js":function(e){e.exports=function(e){try{return!!e()}catch(e){return!0}}},"./node_modules/core-js/internals/function-bind-context.js":function(e,t,r){var n=r("./node_modules/core-js/internals/a-function.js");e.exports=function(e,t,r){if(n(e),void 0===t)return e;switch(r){case 0:return function(){return e.call(t)};case 1:return function(r){return e.call(t,r)};case 2:return function(r,n){return e.call(t,r,n)};case 3:return function(r,n,o){return e.call(t,r,n,o)}}return function(){return e.apply(t,arguments)}}},"./node_modules/core-js/internals/get-built-in.js":function(e,t,r){var n=r("./node_modules/core-js/internals/global.js"),o=function(e){return"function"==typeof e?e:void 0};e.exports=function(e,t){return arguments.length<2?o(n[e]):n[e]&&n[e][t]}},"./node_modules/core-js/internals/global.js":function(e){var t=function(e){return e&&e.Math==Math&&e};e.exports=t("object"==typeof globalThis&&globalThis)||t("object"==typeof window&&window)||t("object"==typeof self&&self)||t("object"==typeof global&&global)||function(){return this}()||Function("return this")()},"./node_modules/core-js/internals/has.js":function(e,t,r){var n=r("./node_modules/core-js/internals/to-object.js"),o={}.hasOwnProperty;e.exports=Object.hasOwn||function(e,t){return o.call(n(e),t)}},"./node_modules/core-js/internals/hidden-keys.js":function(e){e.exports={}},"./node_modules/core-js/internals/html.js":function(e,t,r){var n=r("./node_modules/core-js/internals/get-built-in.js");e.exports=n("document","documentElement")},"./node_modules/core-js/internals/ie8-dom-define.js":function(e,t,r){var n=r("./node_modules/core-js/internals/descriptors.js"),o=r("./node_modules/core-js/internals/fails.js"),s=r("./node_modules/core-js/internals/document-create-element.js");e.exports=!n&&!o((function(){return 7!=Object.defineProperty(s("div"),"a",{get:function(){return 7}}).a}))},"./node_modules/core-js/internals/indexed-object.js":function(e,t,r){var n=r("./node_modules/core-js/internals/fails.js"),o=r("./node_modules/core-js/internals/classof-raw.js"),s="".split;e.exports=n((function(){return!Object("z").propertyIsEnumerable(0)}))?function(e){return"String"==o(e)?s.call(e,""):Object(e)}:Object},"./node_modules/core-js/internals/inherit-if-required.js":function(e,t,r){var n=r("./node_modules/core-js/internals/is-object.js"),o=r("./node_modules/core-js/internals/object-set-prototype-of.js");e.exports=function(e,t,r){var s,i;return o&&"function"==typeof(s=t.constructor)&&s!==r&&n(i=s.prototype)&&i!==r.prototype&&o(e,i),e}},"./node_modules/core-js/internals/inspect-source.js":function(e,t,r){var n=r("./node_modules/core-js/internals/shared-store.js"),o=Function.toString;"function"!=typeof n.inspectSource&&(n.inspectSource=function(e){return o.call(e)}),e.exports=n.inspectSource},"./node_modules/core-js/internals/internal-state.js":function(e,t,r){var n,o,s,i=r("./node_modules/core-js/internals/native-weak-map.js"),a=r("./node_modules/core-js/internals/global.js"),A=r("./node_modules/core-js/internals/is-object.js"),u=r("./node_modules/core-js/internals/create-non-enumerable-property.js"),c=r("./node_modules/core-js/internals/has.js"),l=r("./node_modules/core-js/internals/shared-store.js"),d=r("./node_modules/core-js/internals/shared-key.js"),f=r("./node_modules/core-js/internals/hidden-keys.js"),h="Object already initialized",p=a.WeakMap;if(i||l.state){var m=l.state||(l.state=new p),g=m.get,y=m.has,v=m.set;n=function(e,t){if(y.call(m,e))throw new TypeError(h);return t.facade=e,v.call(m,e,t),t},o=function(e){return g.call(m,e)||{}},s=function(e){return y.call(m,e)}}else{var w=d("state");f[w]=!0,n=function(e,t){if(c(e,w))throw new TypeError(h);return t.facade=e,u(e,w,t),t},o=function(e){return c(e,w)?e[w]:{}},s=function(e){return c(e,w)}}e.exports={set:n,get:o,has:s,enforce:function(e){return s(e)?o(e):n(e,{})},getterFor:function(e){return function(t){var r;if(!A(t)||(r=o(t)).type!==e)throw TypeError("Incompatible receiver, "+e+" required");return r}}}},"./node_modules/core-js/internals/is-array.js":function(e,t,r){var n=r("./node_modules/core-js/internals/classof-raw.js");e.exports=Array.isArray||function(e){return"Array"==n(e)}},"./node_modules/core-js/internals/is-forced.js":function(e,t,r){var n=r("./node_modules/core-js/internals/fails.js"),o=/#|\.prototype\./,s=function(e,t){var r=a[i(e)];return r==u||r!=A&&("function"==typeof t?n(t):!!t)},i=s.normalize=function(e){return String(e).replace(o,".").toLowerCase()},a=s.data={},A=s.NATIVE="N",u=s.POLYFILL="P";e.exports=s},"./node_modules/core-js/internals/is-object.js":function(e){e.exports=function(e){return"object"==typeof e?null!==e:"function"==typeof e}},"./node_modules/core-js/internals/is-pure.js":function(e){e.exports=!1},"./node_modules/core-js/internals/is-symbol.js":function(e,t,r){var n=r("./node_modules/core-js/internals/get-built-in.js"),o=r("./node_modules/core-js/internals/use-symbol-as-uid.js");e.exports=o?function(e){return"symbol"==typeof e}:function(e){var t=n("Symbol");return"function"==typeof t&&Object(e)instanceof t}},"./node_modules/core-js/internals/iterators-core.js":function(e,t,r){"use strict";var n,o,s,i=r("./node_modules/core-js/internals/fails.js"),a=r("./node_modules/core-js/internals/object-get-prototype-of.js"),A=r("./node_modules/core-js/internals/create-non-enumerable-property.js"),u=r("./node_modules/core-js/internals/has.js"),c=r("./node_modules/core-js/internals/well-known-symbol.js"),l=r("./node_modules/core-js/internals/is-pure.js"),d=c("iterator"),f=!1;[].keys&&("next"in(s=[].keys())?(o=a(a(s)))!==Object.prototype&&(n=o):f=!0);var h=null==n||i((function(){var e={};return n[d].call(e)!==e}));h&&(n={}),l&&!h||u(n,d)||A(n,d,(function(){return this})),e.exports={IteratorPrototype:n,BUGGY_SAFARI_ITERATORS:f}},"./node_modules/core-js/internals/iterators.js":function(e){e.exports={}},"./node_modules/core-js/internals/native-symbol.js":function(e,t,r){var n=r("./node_modules/core-js/internals/engine-v8-version.js"),o=r("./node_modules/core-js/internals/fails.js");e.exports=!!Object.getOwnPropertySymbols&&!o((function(){var e=Symbol();return!String(e)||!(Object(e)instanceof Symbol)||!Symbol.sham&&n&&n<41}))},"./node_modules/core-js/internals/native-weak-map.js":function(e,t,r){var n=r("./node_modules/core-js/internals/global.js"),o=r("./node_modules/core-js/internals/inspect-source.js"),s=n.WeakMap;e.exports="function"==typeof s&&/native code/.test(o(s))},"./node_modules/core-js/internals/object-assign.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/descriptors.js"),o=r("./node_modules/core-js/internals/fails.js"),s=r("./node_modules/core-js/internals/object-keys.js"),i=r("./node_modules/core-js/internals/object-get-own-property-symbols.js"),a=r("./node_modules/core-js/internals/object-property-is-enumerable.js"),A=r("./node_modules/core-js/internals/to-object.js"),u=r("./node_modules/core-js/internals/indexed-object.js"),c=Object.assign,l=Object.defineProperty;e.exports=!c||o((function(){if(n&&1!==c({b:1},c(l({},"a",{enumerable:!0,get:function(){l(this,"b",{value:3,enumerable:!1})}}),{b:2})).b)return!0;var e={},t={},r=Symbol(),o="abcdefghijklmnopqrst";return e[r]=7,o.split("").forEach((function(e){t[e]=e})),7!=c({},e)[r]||s(c({},t)).join("")!=o}))?function(e,t){for(var r=A(e),o=arguments.length,c=1,l=i.f,d=a.f;o>c;)for(var f,h=u(arguments[c++]),p=l?s(h).concat(l(h)):s(h),m=p.length,g=0;m>g;)f=p[g++],n&&!d.call(h,f)||(r[f]=h[f]);return r}:c},"./node_modules/core-js/internals/object-create.js":function(e,t,r){var n,o=r("./node_modules/core-js/internals/an-object.js"),s=r("./node_modules/core-js/internals/object-define-properties.js"),i=r("./node_modules/core-js/internals/enum-bug-keys.js"),a=r("./node_modules/core-js/internals/hidden-keys.js"),A=r("./node_modules/core-js/internals/html.js"),u=r("./node_modules/core-js/internals/document-create-element.js"),c=r("./node_modules/core-js/internals/shared-key.js")("IE_PROTO"),l=function(){},d=function(e){return"<script>"+e+"<\/script>"},f=function(e){e.write(d("")),e.close();var t=e.parentWindow.Object;return e=null,t},h=function(){try{n=new ActiveXObject("htmlfile")}catch(e){}h=document.domain&&n?f(n):function(){var e,t=u("iframe");if(t.style)return t.style.display="none",A.appendChild(t),t.src=String("javascript:"),(e=t.contentWindow.document).open(),e.write(d("document.F=Object")),e.close(),e.F}()||f(n);for(var e=i.length;e--;)delete h.prototype[i[e]];return h()};a[c]=!0,e.exports=Object.create||function(e,t){var r;return null!==e?(l.prototype=o(e),r=new l,l.prototype=null,r[c]=e):r=h(),void 0===t?r:s(r,t)}},"./node_modules/core-js/internals/object-define-properties.js":function(e,t,r){var n=r("./node_modules/core-js/internals/descriptors.js"),o=r("./node_modules/core-js/internals/object-define-property.js"),s=r("./node_modules/core-js/internals/an-object.js"),i=r("./node_modules/core-js/internals/object-keys.js");e.exports=n?Object.defineProperties:function(e,t){s(e);for(var r,n=i(t),a=n.length,A=0;a>A;)o.f(e,r=n[A++],t[r]);return e}},"./node_modules/core-js/internals/object-define-property.js":function(e,t,r){var n=r("./node_modules/core-js/internals/descriptors.js"),o=r("./node_modules/core-js/internals/ie8-dom-define.js"),s=r("./node_modules/core-js/internals/an-object.js"),i=r("./node_modules/core-js/internals/to-property-key.js"),a=Object.defineProperty;t.f=n?a:function(e,t,r){if(s(e),t=i(t),s(r),o)try{return a(e,t,r)}catch(e){}if("get"in r||"set"in r)throw TypeError("Accessors not supported");return"value"in r&&(e[t]=r.value),e}},"./node_modules/core-js/internals/object-get-own-property-descriptor.js":function(e,t,r){var n=r("./node_modules/core-js/internals/descriptors.js"),o=r("./node_modules/core-js/internals/object-property-is-enumerable.js"),s=r("./node_modules/core-js/internals/create-property-descriptor.js"),i=r("./node_modules/core-js/internals/to-indexed-object.js"),a=r("./node_modules/core-js/internals/to-property-key.js"),A=r("./node_modules/core-js/internals/has.js"),u=r("./node_modules/core-js/internals/ie8-dom-define.js"),c=Object.getOwnPropertyDescriptor;t.f=n?c:function(e,t){if(e=i(e),t=a(t),u)try{return c(e,t)}catch(e){}if(A(e,t))return s(!o.f.call(e,t),e[t])}},"./node_modules/core-js/internals/object-get-own-property-names-external.js":function(e,t,r){var n=r("./node_modules/core-js/internals/to-indexed-object.js"),o=r("./node_modules/core-js/internals/object-get-own-property-names.js").f,s={}.toString,i="object"==typeof window&&window&&Object.getOwnPropertyNames?Object.getOwnPropertyNames(window):[];e.exports.f=function(e){return i&&"[object Window]"==s.call(e)?function(e){try{return o(e)}catch(e){return i.slice()}}(e):o(n(e))}},"./node_modules/core-js/internals/object-get-own-property-names.js":function(e,t,r){var n=r("./node_modules/core-js/internals/object-keys-internal.js"),o=r("./node_modules/core-js/internals/enum-bug-keys.js").concat("length","prototype");t.f=Object.getOwnPropertyNames||function(e){return n(e,o)}},"./node_modules/core-js/internals/object-get-own-property-symbols.js":function(e,t){t.f=Object.getOwnPropertySymbols},"./node_modules/core-js/internals/object-get-prototype-of.js":function(e,t,r){var n=r("./node_modules/core-js/internals/has.js"),o=r("./node_modules/core-js/internals/to-object.js"),s=r("./node_modules/core-js/internals/shared-key.js"),i=r("./node_modules/core-js/internals/correct-prototype-getter.js"),a=s("IE_PROTO"),A=Object.prototype;e.exports=i?Object.getPrototypeOf:function(e){return e=o(e),n(e,a)?e[a]:"function"==typeof e.constructor&&e instanceof e.constructor?e.constructor.prototype:e instanceof Object?A:null}},"./node_modules/core-js/internals/object-keys-internal.js":function(e,t,r){var n=r("./node_modules/core-js/internals/has.js"),o=r("./node_modules/core-js/internals/to-indexed-object.js"),s=r("./node_modules/core-js/internals/array-includes.js").indexOf,i=r("./node_modules/core-js/internals/hidden-keys.js");e.exports=function(e,t){var r,a=o(e),A=0,u=[];for(r in a)!n(i,r)&&n(a,r)&&u.push(r);for(;t.length>A;)n(a,r=t[A++])&&(~s(u,r)||u.push(r));return u}},"./node_modules/core-js/internals/object-keys.js":function(e,t,r){var n=r("./node_modules/core-js/internals/object-keys-internal.js"),o=r("./node_modules/core-js/internals/enum-bug-keys.js");e.exports=Object.keys||function(e){return n(e,o)}},"./node_modules/core-js/internals/object-property-is-enumerable.js":function(e,t){"use strict";var r={}.propertyIsEnumerable,n=Object.getOwnPropertyDescriptor,o=n&&!r.call({1:2},1);t.f=o?function(e){var t=n(this,e);return!!t&&t.enumerable}:r},"./node_modules/core-js/internals/object-set-prototype-of.js":function(e,t,r){var n=r("./node_modules/core-js/internals/an-object.js"),o=r("./node_modules/core-js/internals/a-possible-prototype.js");e.exports=Object.setPrototypeOf||("__proto__"in{}?function(){var e,t=!1,r={};try{(e=Object.getOwnPropertyDescriptor(Object.prototype,"__proto__").set).call(r,[]),t=r instanceof Array}catch(e){}return function(r,s){return n(r),o(s),t?e.call(r,s):r.__proto__=s,r}}():void 0)},"./node_modules/core-js/internals/object-to-string.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/to-string-tag-support.js"),o=r("./node_modules/core-js/internals/classof.js");e.exports=n?{}.toString:function(){return"[object "+o(this)+"]"}},"./node_modules/core-js/internals/ordinary-to-primitive.js":function(e,t,r){var n=r("./node_modules/core-js/internals/is-object.js");e.exports=function(e,t){var r,o;if("string"===t&&"function"==typeof(r=e.toString)&&!n(o=r.call(e)))return o;if("function"==typeof(r=e.valueOf)&&!n(o=r.call(e)))return o;if("string"!==t&&"function"==typeof(r=e.toString)&&!n(o=r.call(e)))return o;throw TypeError("Can't convert object to primitive value")}},"./node_modules/core-js/internals/own-keys.js":function(e,t,r){var n=r("./node_modules/core-js/internals/get-built-in.js"),o=r("./node_modules/core-js/internals/object-get-own-property-names.js"),s=r("./node_modules/core-js/internals/object-get-own-property-symbols.js"),i=r("./node_modules/core-js/internals/an-object.js");e.exports=n("Reflect","ownKeys")||function(e){var t=o.f(i(e)),r=s.f;return r?t.concat(r(e)):t}},"./node_modules/core-js/internals/path.js":function(e,t,r){var n=r("./node_modules/core-js/internals/global.js");e.exports=n},"./node_modules/core-js/internals/redefine.js":function(e,t,r){var n=r("./node_modules/core-js/internals/global.js"),o=r("./node_modules/core-js/internals/create-non-enumerable-property.js"),s=r("./node_modules/core-js/internals/has.js"),i=r("./node_modules/core-js/internals/set-global.js"),a=r("./node_modules/core-js/internals/inspect-source.js"),A=r("./node_modules/core-js/internals/internal-state.js"),u=A.get,c=A.enforce,l=String(String).split("String");(e.exports=function(e,t,r,a){var A,u=!!a&&!!a.unsafe,d=!!a&&!!a.enumerable,f=!!a&&!!a.noTargetGet;"function"==typeof r&&("string"!=typeof t||s(r,"name")||o(r,"name",t),(A=c(r)).source||(A.source=l.join("string"==typeof t?t:""))),e!==n?(u?!f&&e[t]&&(d=!0):delete e[t],d?e[t]=r:o(e,t,r)):d?e[t]=r:i(t,r)})(Function.prototype,"toString",(function(){return"function"==typeof this&&u(this).source||a(this)}))},"./node_modules/core-js/internals/regexp-flags.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/an-object.js");e.exports=function(){var e=n(this),t="";return e.global&&(t+="g"),e.ignoreCase&&(t+="i"),e.multiline&&(t+="m"),e.dotAll&&(t+="s"),e.unicode&&(t+="u"),e.sticky&&(t+="y"),t}},"./node_modules/core-js/internals/require-object-coercible.js":function(e){e.exports=function(e){if(null==e)throw TypeError("Can't call method on "+e);return e}},"./node_modules/core-js/internals/set-global.js":function(e,t,r){var n=r("./node_modules/core-js/internals/global.js");e.exports=function(e,t){try{Object.defineProperty(n,e,{value:t,configurable:!0,writable:!0})}catch(r){n[e]=t}return t}},"./node_modules/core-js/internals/set-to-string-tag.js":function(e,t,r){var n=r("./node_modules/core-js/internals/object-define-property.js").f,o=r("./node_modules/core-js/internals/has.js"),s=r("./node_modules/core-js/internals/well-known-symbol.js")("toStringTag");e.exports=function(e,t,r){e&&!o(e=r?e:e.prototype,s)&&n(e,s,{configurable:!0,value:t})}},"./node_modules/core-js/internals/shared-key.js":function(e,t,r){var n=r("./node_modules/core-js/internals/shared.js"),o=r("./node_modules/core-js/internals/uid.js"),s=n("keys");e.exports=function(e){return s[e]||(s[e]=o(e))}},"./node_modules/core-js/internals/shared-store.js":function(e,t,r){var n=r("./node_modules/core-js/internals/global.js"),o=r("./node_modules/core-js/internals/set-global.js"),s="__core-js_shared__",i=n[s]||o(s,{});e.exports=i},"./node_modules/core-js/internals/shared.js":function(e,t,r){var n=r("./node_modules/core-js/internals/is-pure.js"),o=r("./node_modules/core-js/internals/shared-store.js");(e.exports=function(e,t){return o[e]||(o[e]=void 0!==t?t:{})})("versions",[]).push({version:"3.16.0",mode:n?"pure":"global",copyright:"© 2021 Denis Pushkarev (zloirock.ru)"})},"./node_modules/core-js/internals/string-html-forced.js":function(e,t,r){var n=r("./node_modules/core-js/internals/fails.js");e.exports=function(e){return n((function(){var t=""[e]('"');return t!==t.toLowerCase()||t.split('"').length>3}))}},"./node_modules/core-js/internals/string-multibyte.js":function(e,t,r){var n=r("./node_modules/core-js/internals/to-integer.js"),o=r("./node_modules/core-js/internals/to-string.js"),s=r("./node_modules/core-js/internals/require-object-coercible.js"),i=function(e){return function(t,r){var i,a,A=o(s(t)),u=n(r),c=A.length;return u<0||u>=c?e?"":void 0:(i=A.charCodeAt(u))<55296||i>56319||u+1===c||(a=A.charCodeAt(u+1))<56320||a>57343?e?A.charAt(u):i:e?A.slice(u,u+2):a-56320+(i-55296<<10)+65536}};e.exports={codeAt:i(!1),charAt:i(!0)}},"./node_modules/core-js/internals/string-trim.js":function(e,t,r){var n=r("./node_modules/core-js/internals/require-object-coercible.js"),o=r("./node_modules/core-js/internals/to-string.js"),s="["+r("./node_modules/core-js/internals/whitespaces.js")+"]",i=RegExp("^"+s+s+"*"),a=RegExp(s+s+"*$"),A=function(e){return function(t){var r=o(n(t));return 1&e&&(r=r.replace(i,"")),2&e&&(r=r.replace(a,"")),r}};e.exports={start:A(1),end:A(2),trim:A(3)}},"./node_modules/core-js/internals/to-absolute-index.js":function(e,t,r){var n=r("./node_modules/core-js/internals/to-integer.js"),o=Math.max,s=Math.min;e.exports=function(e,t){var r=n(e);return r<0?o(r+t,0):s(r,t)}},"./node_modules/core-js/internals/to-indexed-object.js":function(e,t,r){var n=r("./node_modules/core-js/internals/indexed-object.js"),o=r("./node_modules/core-js/internals/require-object-coercible.js");e.exports=function(e){return n(o(e))}},"./node_modules/core-js/internals/to-integer.js":function(e){var t=Math.ceil,r=Math.floor;e.exports=function(e){return isNaN(e=+e)?0:(e>0?r:t)(e)}},"./node_modules/core-js/internals/to-length.js":function(e,t,r){var n=r("./node_modules/core-js/internals/to-integer.js"),o=Math.min;e.exports=function(e){return e>0?o(n(e),9007199254740991):0}},"./node_modules/core-js/internals/to-object.js":function(e,t,r){var n=r("./node_modules/core-js/internals/require-object-coercible.js");e.exports=function(e){return Object(n(e))}},"./node_modules/core-js/internals/to-primitive.js":function(e,t,r){var n=r("./node_modules/core-js/internals/is-object.js"),o=r("./node_modules/core-js/internals/is-symbol.js"),s=r("./node_modules/core-js/internals/ordinary-to-primitive.js"),i=r("./node_modules/core-js/internals/well-known-symbol.js")("toPrimitive");e.exports=function(e,t){if(!n(e)||o(e))return e;var r,a=e[i];if(void 0!==a){if(void 0===t&&(t="default"),r=a.call(e,t),!n(r)||o(r))return r;throw TypeError("Can't convert object to primitive value")}return void 0===t&&(t="number"),s(e,t)}},"./node_modules/core-js/internals/to-property-key.js":function(e,t,r){var n=r("./node_modules/core-js/internals/to-primitive.js"),o=r("./node_modules/core-js/internals/is-symbol.js");e.exports=function(e){var t=n(e,"string");return o(t)?t:String(t)}},"./node_modules/core-js/internals/to-string-tag-support.js":function(e,t,r){var n={};n[r("./node_modules/core-js/internals/well-known-symbol.js")("toStringTag")]="z",e.exports="[object z]"===String(n)},"./node_modules/core-js/internals/to-string.js":function(e,t,r){var n=r("./node_modules/core-js/internals/is-symbol.js");e.exports=function(e){if(n(e))throw TypeError("Cannot convert a Symbol value to a string");return String(e)}},"./node_modules/core-js/internals/uid.js":function(e){var t=0,r=Math.random();e.exports=function(e){return"Symbol("+String(void 0===e?"":e)+")_"+(++t+r).toString(36)}},"./node_modules/core-js/internals/use-symbol-as-uid.js":function(e,t,r){var n=r("./node_modules/core-js/internals/native-symbol.js");e.exports=n&&!Symbol.sham&&"symbol"==typeof Symbol.iterator},"./node_modules/core-js/internals/well-known-symbol-wrapped.js":function(e,t,r){var n=r("./node_modules/core-js/internals/well-known-symbol.js");t.f=n},"./node_modules/core-js/internals/well-known-symbol.js":function(e,t,r){var n=r("./node_modules/core-js/internals/global.js"),o=r("./node_modules/core-js/internals/shared.js"),s=r("./node_modules/core-js/internals/has.js"),i=r("./node_modules/core-js/internals/uid.js"),a=r("./node_modules/core-js/internals/native-symbol.js"),A=r("./node_modules/core-js/internals/use-symbol-as-uid.js"),u=o("wks"),c=n.Symbol,l=A?c:c&&c.withoutSetter||i;e.exports=function(e){return s(u,e)&&(a||"string"==typeof u[e])||(a&&s(c,e)?u[e]=c[e]:u[e]=l("Symbol."+e)),u[e]}},"./node_modules/core-js/internals/whitespaces.js":function(e){e.exports="\t\n\v\f\r                　\u2028\u2029\ufeff"},"./node_modules/core-js/modules/es.array.concat.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/export.js"),o=r("./node_modules/core-js/internals/fails.js"),s=r("./node_modules/core-js/internals/is-array.js"),i=r("./node_modules/core-js/internals/is-object.js"),a=r("./node_modules/core-js/internals/to-object.js"),A=r("./node_modules/core-js/internals/to-length.js"),u=r("./node_modules/core-js/internals/create-property.js"),c=r("./node_modules/core-js/internals/array-species-create.js"),l=r("./node_modules/core-js/internals/array-method-has-species-support.js"),d=r("./node_modules/core-js/internals/well-known-symbol.js"),f=r("./node_modules/core-js/internals/engine-v8-version.js"),h=d("isConcatSpreadable"),p=9007199254740991,m="Maximum allowed index exceeded",g=f>=51||!o((function(){var e=[];return e[h]=!1,e.concat()[0]!==e})),y=l("concat"),v=function(e){if(!i(e))return!1;var t=e[h];return void 0!==t?!!t:s(e)};n({target:"Array",proto:!0,forced:!g||!y},{concat:function(e){var t,r,n,o,s,i=a(this),l=c(i,0),d=0;for(t=-1,n=arguments.length;t<n;t++)if(v(s=-1===t?i:arguments[t])){if(d+(o=A(s.length))>p)throw TypeError(m);for(r=0;r<o;r++,d++)r in s&&u(l,d,s[r])}else{if(d>=p)throw TypeError(m);u(l,d++,s)}return l.length=d,l}})},"./node_modules/core-js/modules/es.array.iterator.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/to-indexed-object.js"),o=r("./node_modules/core-js/internals/add-to-unscopables.js"),s=r("./node_modules/core-js/internals/iterators.js"),i=r("./node_modules/core-js/internals/internal-state.js"),a=r("./node_modules/core-js/internals/define-iterator.js"),A="Array Iterator",u=i.set,c=i.getterFor(A);e.exports=a(Array,"Array",(function(e,t){u(this,{type:A,target:n(e),index:0,kind:t})}),(function(){var e=c(this),t=e.target,r=e.kind,n=e.index++;return!t||n>=t.length?(e.target=void 0,{value:void 0,done:!0}):"keys"==r?{value:n,done:!1}:"values"==r?{value:t[n],done:!1}:{value:[n,t[n]],done:!1}}),"values"),s.Arguments=s.Array,o("keys"),o("values"),o("entries")},"./node_modules/core-js/modules/es.array.join.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/export.js"),o=r("./node_modules/core-js/internals/indexed-object.js"),s=r("./node_modules/core-js/internals/to-indexed-object.js"),i=r("./node_modules/core-js/internals/array-method-is-strict.js"),a=[].join,A=o!=Object,u=i("join",",");n({target:"Array",proto:!0,forced:A||!u},{join:function(e){return a.call(s(this),void 0===e?",":e)}})},"./node_modules/core-js/modules/es.array.map.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/export.js"),o=r("./node_modules/core-js/internals/array-iteration.js").map;n({target:"Array",proto:!0,forced:!r("./node_modules/core-js/internals/array-method-has-species-support.js")("map")},{map:function(e){return o(this,e,arguments.length>1?arguments[1]:void 0)}})},"./node_modules/core-js/modules/es.array.slice.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/export.js"),o=r("./node_modules/core-js/internals/is-object.js"),s=r("./node_modules/core-js/internals/is-array.js"),i=r("./node_modules/core-js/internals/to-absolute-index.js"),a=r("./node_modules/core-js/internals/to-length.js"),A=r("./node_modules/core-js/internals/to-indexed-object.js"),u=r("./node_modules/core-js/internals/create-property.js"),c=r("./node_modules/core-js/internals/well-known-symbol.js"),l=r("./node_modules/core-js/internals/array-method-has-species-support.js")("slice"),d=c("species"),f=[].slice,h=Math.max;n({target:"Array",proto:!0,forced:!l},{slice:function(e,t){var r,n,c,l=A(this),p=a(l.length),m=i(e,p),g=i(void 0===t?p:t,p);if(s(l)&&("function"!=typeof(r=l.constructor)||r!==Array&&!s(r.prototype)?o(r)&&null===(r=r[d])&&(r=void 0):r=void 0,r===Array||void 0===r))return f.call(l,m,g);for(n=new(void 0===r?Array:r)(h(g-m,0)),c=0;m<g;m++,c++)m in l&&u(n,c,l[m]);return n.length=c,n}})},"./node_modules/core-js/modules/es.function.name.js":function(e,t,r){var n=r("./node_modules/core-js/internals/descriptors.js"),o=r("./node_modules/core-js/internals/object-define-property.js").f,s=Function.prototype,i=s.toString,a=/^\s*function ([^ (]*)/,A="name";n&&!(A in s)&&o(s,A,{configurable:!0,get:function(){try{return i.call(this).match(a)[1]}catch(e){return""}}})},"./node_modules/core-js/modules/es.number.constructor.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/descriptors.js"),o=r("./node_modules/core-js/internals/global.js"),s=r("./node_modules/core-js/internals/is-forced.js"),i=r("./node_modules/core-js/internals/redefine.js"),a=r("./node_modules/core-js/internals/has.js"),A=r("./node_modules/core-js/internals/classof-raw.js"),u=r("./node_modules/core-js/internals/inherit-if-required.js"),c=r("./node_modules/core-js/internals/is-symbol.js"),l=r("./node_modules/core-js/internals/to-primitive.js"),d=r("./node_modules/core-js/internals/fails.js"),f=r("./node_modules/core-js/internals/object-create.js"),h=r("./node_modules/core-js/internals/object-get-own-property-names.js").f,p=r("./node_modules/core-js/internals/object-get-own-property-descriptor.js").f,m=r("./node_modules/core-js/internals/object-define-property.js").f,g=r("./node_modules/core-js/internals/string-trim.js").trim,y="Number",v=o.Number,w=v.prototype,b=A(f(w))==y,B=function(e){if(c(e))throw TypeError("Cannot convert a Symbol value to a number");var t,r,n,o,s,i,a,A,u=l(e,"number");if("string"==typeof u&&u.length>2)if(43===(t=(u=g(u)).charCodeAt(0))||45===t){if(88===(r=u.charCodeAt(2))||120===r)return NaN}else if(48===t){switch(u.charCodeAt(1)){case 66:case 98:n=2,o=49;break;case 79:case 111:n=8,o=55;break;default:return+u}for(i=(s=u.slice(2)).length,a=0;a<i;a++)if((A=s.charCodeAt(a))<48||A>o)return NaN;return parseInt(s,n)}return+u};if(s(y,!v(" 0o1")||!v("0b1")||v("+0x1"))){for(var j,_=function(e){var t=arguments.length<1?0:e,r=this;return r instanceof _&&(b?d((function(){w.valueOf.call(r)})):A(r)!=y)?u(new v(B(t)),r,_):B(t)},C=n?h(v):"MAX_VALUE,MIN_VALUE,NaN,NEGATIVE_INFINITY,POSITIVE_INFINITY,EPSILON,isFinite,isInteger,isNaN,isSafeInteger,MAX_SAFE_INTEGER,MIN_SAFE_INTEGER,parseFloat,parseInt,isInteger,fromString,range".split(","),x=0;C.length>x;x++)a(v,j=C[x])&&!a(_,j)&&m(_,j,p(v,j));_.prototype=w,w.constructor=_,i(o,y,_)}},"./node_modules/core-js/modules/es.object.assign.js":function(e,t,r){var n=r("./node_modules/core-js/internals/export.js"),o=r("./node_modules/core-js/internals/object-assign.js");n({target:"Object",stat:!0,forced:Object.assign!==o},{assign:o})},"./node_modules/core-js/modules/es.object.keys.js":function(e,t,r){var n=r("./node_modules/core-js/internals/export.js"),o=r("./node_modules/core-js/internals/to-object.js"),s=r("./node_modules/core-js/internals/object-keys.js");n({target:"Object",stat:!0,forced:r("./node_modules/core-js/internals/fails.js")((function(){s(1)}))},{keys:function(e){return s(o(e))}})},"./node_modules/core-js/modules/es.object.to-string.js":function(e,t,r){var n=r("./node_modules/core-js/internals/to-string-tag-support.js"),o=r("./node_modules/core-js/internals/redefine.js"),s=r("./node_modules/core-js/internals/object-to-string.js");n||o(Object.prototype,"toString",s,{unsafe:!0})},"./node_modules/core-js/modules/es.regexp.to-string.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/redefine.js"),o=r("./node_modules/core-js/internals/an-object.js"),s=r("./node_modules/core-js/internals/to-string.js"),i=r("./node_modules/core-js/internals/fails.js"),a=r("./node_modules/core-js/internals/regexp-flags.js"),A="toString",u=RegExp.prototype,c=u.toString,l=i((function(){return"/a/b"!=c.call({source:"a",flags:"b"})})),d=c.name!=A;(l||d)&&n(RegExp.prototype,A,(function(){var e=o(this),t=s(e.source),r=e.flags;return"/"+t+"/"+s(void 0===r&&e instanceof RegExp&&!("flags"in u)?a.call(e):r)}),{unsafe:!0})},"./node_modules/core-js/modules/es.string.iterator.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/string-multibyte.js").charAt,o=r("./node_modules/core-js/internals/to-string.js"),s=r("./node_modules/core-js/internals/internal-state.js"),i=r("./node_modules/core-js/internals/define-iterator.js"),a="String Iterator",A=s.set,u=s.getterFor(a);i(String,"String",(function(e){A(this,{type:a,string:o(e),index:0})}),(function(){var e,t=u(this),r=t.string,o=t.index;return o>=r.length?{value:void 0,done:!0}:(e=n(r,o),t.index+=e.length,{value:e,done:!1})}))},"./node_modules/core-js/modules/es.string.link.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/export.js"),o=r("./node_modules/core-js/internals/create-html.js");n({target:"String",proto:!0,forced:r("./node_modules/core-js/internals/string-html-forced.js")("link")},{link:function(e){return o(this,"a","href",e)}})},"./node_modules/core-js/modules/es.symbol.description.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/export.js"),o=r("./node_modules/core-js/internals/descriptors.js"),s=r("./node_modules/core-js/internals/global.js"),i=r("./node_modules/core-js/internals/has.js"),a=r("./node_modules/core-js/internals/is-object.js"),A=r("./node_modules/core-js/internals/object-define-property.js").f,u=r("./node_modules/core-js/internals/copy-constructor-properties.js"),c=s.Symbol;if(o&&"function"==typeof c&&(!("description"in c.prototype)||void 0!==c().description)){var l={},d=function(){var e=arguments.length<1||void 0===arguments[0]?void 0:String(arguments[0]),t=this instanceof d?new c(e):void 0===e?c():c(e);return""===e&&(l[t]=!0),t};u(d,c);var f=d.prototype=c.prototype;f.constructor=d;var h=f.toString,p="Symbol(test)"==String(c("test")),m=/^Symbol\((.*)\)[^)]+$/;A(f,"description",{configurable:!0,get:function(){var e=a(this)?this.valueOf():this,t=h.call(e);if(i(l,e))return"";var r=p?t.slice(7,-1):t.replace(m,"$1");return""===r?void 0:r}}),n({global:!0,forced:!0},{Symbol:d})}},"./node_modules/core-js/modules/es.symbol.iterator.js":function(e,t,r){r("./node_modules/core-js/internals/define-well-known-symbol.js")("iterator")},"./node_modules/core-js/modules/es.symbol.js":function(e,t,r){"use strict";var n=r("./node_modules/core-js/internals/export.js"),o=r("./node_modules/core-js/internals/global.js"),s=r("./node_modules/core-js/internals/get-built-in.js"),i=r("./node_modules/core-js/internals/is-pure.js"),a=r("./node_modules/core-js/internals/descriptors.js"),A=r("./node_modules/core-js/internals/native-symbol.js"),u=r("./node_modules/core-js/internals/fails.js"),c=r("./node_modules/core-js/internals/has.js"),l=r("./node_modules/core-js/internals/is-array.js"),d=r("./node_modules/core-js/internals/is-object.js"),f=r("./node_modules/core-js/internals/is-symbol.js"),h=r("./node_modules/core-js/internals/an-object.js"),p=r("./node_modules/core-js/internals/to-object.js"),m=r("./node_modules/core-js/internals/to-indexed-object.js"),g=r("./node_modules/core-js/internals/to-property-key.js"),y=r("./node_modules/core-js/internals/to-string.js"),v=r("./node_modules/core-js/internals/create-property-descriptor.js"),w=r("./node_modules/core-js/internals/object-create.js"),b=r("./node_modules/core-js/internals/object-keys.js"),B=r("./node_modules/core-js/internals/object-get-own-property-names.js"),j=r("./node_modules/core-js/internals/object-get-own-property-names-external.js"),_=r("./node_modules/core-js/internals/object-get-own-property-symbols.js"),C=r("./node_modules/core-js/internals/object-get-own-property-descriptor.js"),x=r("./node_modules/core-js/internals/object-define-property.js"),E=r("./node_modules/core-js/internals/object-property-is-enumerable.js"),N=r("./node_modules/core-js/internals/create-non-enumerable-property.js"),Q=r("./node_modules/core-js/internals/redefine.js"),F=r("./node_modules/core-js/internals/shared.js"),U=r("./node_modules/core-js/internals/shared-key.js"),S=r("./node_modules/core-js/internals/hidden-keys.js"),L=r("./node_modules/core-js/internals/uid.js"),T=r("./node_modules/core-js/internals/well-known-symbol.js"),H=r("./node_modules/core-js/internals/well-known-symbol-wrapped.js"),I=r("./node_modules/core-js/internals/define-well-known-symbol.js"),P=r("./node_modules/core-js/internals/set-to-string-tag.js"),O=r("./node_modules/core-js/internals/internal-state.js"),k=r("./node_modules/core-js/internals/array-iteration.js").forEach,R=U("hidden"),M="Symbol",D=T("toPrimitive"),K=O.set,z=O.getterFor(M),V=Object.prototype,q=o.Symbol,G=s("JSON","stringify"),X=C.f,W=x.f,J=j.f,Y=E.f,Z=F("symbols"),$=F("op-symbols"),ee=F("string-to-symbol-registry"),te=F("symbol-to-string-registry"),re=F("wks"),ne=o.QObject,oe=!ne||!ne.prototype||!ne.prototype.findChild,se=a&&u((function(){return 7!=w(W({},"a",{get:function(){return W(this,"a",{value:7}).a}})).a}))?function(e,t,r){var n=X(V,t);n&&delete V[t],W(e,t,r),n&&e!==V&&W(V,t,n)}:W,ie=function(e,t){var r=Z[e]=w(q.prototype);return K(r,{type:M,tag:e,description:t}),a||(r.description=t),r},ae=function(e,t,r){e===V&&ae($,t,r),h(e);var n=g(t);return h(r),c(Z,n)?(r.enumerable?(c(e,R)&&e[R][n]&&(e[R][n]=!1),r=w(r,{enumerable:v(0,!1)})):(c(e,R)||W(e,R,v(1,{})),e[R][n]=!0),se(e,n,r)):W(e,n,r)},Ae=function(e,t){h(e);var r=m(t),n=b(r).concat(de(r));return k(n,(function(t){a&&!ue.call(r,t)||ae(e,t,r[t])})),e},ue=function(e){var t=g(e),r=Y.call(this,t);return!(this===V&&c(Z,t)&&!c($,t))&&(!(r||!c(this,t)||!c(Z,t)||c(this,R)&&this[R][t])||r)},ce=function(e,t){var r=m(e),n=g(t);if(r!==V||!c(Z,n)||c($,n)){var o=X(r,n);return!o||!c(Z,n)||c(r,R)&&r[R][n]||(o.enumerable=!0),o}},le=function(e){var t=J(m(e)),r=[];return k(t,(function(e){c(Z,e)||c(S,e)||r.push(e)})),r},de=function(e){var t=e===V,r=J(t?$:m(e)),n=[];return k(r,(function(e){!c(Z,e)||t&&!c(V,e)||n.push(Z[e])})),n};A||(Q((q=function(){if(this instanceof q)throw TypeError("Symbol is not a constructor");var e=arguments.length&&void 0!==arguments[0]?y(arguments[0]):void 0,t=L(e),r=function(e){this===V&&r.call($,e),c(this,R)&&c(this[R],t)&&(this[R][t]=!1),se(this,t,v(1,e))};return a&&oe&&se(V,t,{configurable:!0,set:r}),ie(t,e)}).prototype,"toString",(function(){return z(this).tag})),Q(q,"withoutSetter",(function(e){return ie(L(e),e)})),E.f=ue,x.f=ae,C.f=ce,B.f=j.f=le,_.f=de,H.f=function(e){return ie(T(e),e)},a&&(W(q.prototype,"description",{configurable:!0,get:function(){return z(this).description}}),i||Q(V,"propertyIsEnumerable",ue,{unsafe:!0}))),n({global:!0,wrap:!0,forced:!A,sham:!A},{Symbol:q}),k(b(re),(function(e){I(e)})),n({target:M,stat:!0,forced:!A},{for:function(e){var t=y(e);if(c(ee,t))return ee[t];var r=q(t);return ee[t]=r,te[r]=t,r},keyFor:function(e){if(!f(e))throw TypeError(e+" is not a symbol");if(c(te,e))return te[e]},useSetter:function(){oe=!0},useSimple:function(){oe=!1}}),n({target:"Object",stat:!0,forced:!A,sham:!a},{create:function(e,t){return void 0===t?w(e):Ae(w(e),t)},defineProperty:ae,defineProperties:Ae,getOwnPropertyDescriptor:ce}),n({target:"Object",stat:!0,forced:!A},{getOwnPropertyNames:le,getOwnPropertySymbols:de}),n({target:"Object",stat:!0,forced:u((function(){_.f(1)}))},{getOwnPropertySymbols:function(e){return _.f(p(e))}}),G&&n({target:"JSON",stat:!0,forced:!A||u((function(){var e=q();return"[null]"!=G([e])||"{}"!=G({a:e})||"{}"!=G(Object(e))}))},{stringify:function(e,t,r){for(var n,o=[e],s=1;arguments.length>s;)o.push(arguments[s++]);if(n=t,(d(t)||void 0!==e)&&!f(e))return l(t)||(t=function(e,t){if("function"==typeof n&&(t=n.call(this,e,t)),!f(t))return t}),o[1]=t,G.apply(null,o)}}),q.prototype[D]||N(q.prototype,D,q.prototype.valueOf),P(q,M),S[R]=!0},"./node_modules/core-js/modules/web.dom-collections.for-each.js":function(e,t,r){var n=r("./node_modules/core-js/internals/global.js"),o=r("./node_modules/core-js/internals/dom-iterables.js"),s=r("./node_modules/core-js/internals/array-for-each.js"),i=r("./node_modules/core-js/internals/create-non-enumerable-property.js");for(var a in o){var A=n[a],u=A&&A.prototype;if(u&&u.forEach!==s)try{i(u,"forEach",s)}catch(e){u.forEach=s}}},"./node_modules/core-js/modules/web.dom-collections.iterator.js":function(e,t,r){var n=r("./node_modules/core-js/internals/global.js"),o=r("./node_modules/core-js/internals/dom-iterables.js"),s=r("./node_modules/core-js/modules/es.array.iterator.js"),i=r("./node_modules/core-js/internals/create-non-enumerable-property.js"),a=r("./node_modules/core-js/internals/well-known-symbol.js"),A=a("iterator"),u=a("toStringTag"),c=s.values;for(var l in o){var d=n[l],f=d&&d.prototype;if(f){if(f[A]!==c)try{i(f,A,c)}catch(e){f[A]=c}if(f[u]||i(f,u,l),o[l])for(var h in s)if(f[h]!==s[h])try{i(f,h,s[h])}catch(e){f[h]=s[h]}}}},"./node_modules/dompurify/dist/purify.js":function(e){e.exports=function(){"use strict";var e=Object.hasOwnProperty,t=Object.setPrototypeOf,r=Object.isFrozen,n=Object.getPrototypeOf,o=Object.getOwnPropertyDescriptor,s=Object.freeze,i=Object.seal,a=Object.create,A="undefined"!=typeof Reflect&&Reflect,u=A.apply,c=A.construct;u||(u=function(e,t,r){return e.apply(t,r)}),s||(s=function(e){return e}),i||(i=function(e){return e}),c||(c=function(e,t){return new(Function.prototype.bind.apply(e,[null].concat(function(e){if(Array.isArray(e)){for(var t=0,r=Array(e.length);t<e.length;t++)r[t]=e[t];return r}return Array.from(e)}(t))))});var l,d=B(Array.prototype.forEach),f=B(Array.prototype.pop),h=B(Array.prototype.push),p=B(String.prototype.toLowerCase),m=B(String.prototype.match),g=B(String.prototype.replace),y=B(String.prototype.indexOf),v=B(String.prototype.trim),w=B(RegExp.prototype.test),b=(l=TypeError,function(){for(var e=arguments.length,t=Array(e),r=0;r<e;r++)t[r]=arguments[r];return c(l,t)});function B(e){return function(t){for(var r=arguments.length,n=Array(r>1?r-1:0),o=1;o<r;o++)n[o-1]=arguments[o];return u(e,t,n)}}function j(e,n){t&&t(e,null);for(var o=n.length;o--;){var s=n[o];if("string"==typeof s){var i=p(s);i!==s&&(r(n)||(n[o]=i),s=i)}e[s]=!0}return e}function _(t){var r=a(null),n=void 0;for(n in t)u(e,t,[n])&&(r[n]=t[n]);return r}function C(e,t){for(;null!==e;){var r=o(e,t);if(r){if(r.get)return B(r.get);if("function"==typeof r.value)return B(r.value)}e=n(e)}return function(e){return console.warn("fallback value for",e),null}}var x=s(["a","abbr","acronym","address","area","article","aside","audio","b","bdi","bdo","big","blink","blockquote","body","br","button","canvas","caption","center","cite","code","col","colgroup","content","data","datalist","dd","decorator","del","details","dfn","dialog","dir","div","dl","dt","element","em","fieldset","figcaption","figure","font","footer","form","h1","h2","h3","h4","h5","h6","head","header","hgroup","hr","html","i","img","input","ins","kbd","label","legend","li","main","map","mark","marquee","menu","menuitem","meter","nav","nobr","ol","optgroup","option","output","p","picture","pre","progress","q","rp","rt","ruby","s","samp","section","select","shadow","small","source","spacer","span","strike","strong","style","sub","summary","sup","table","tbody","td","template","textarea","tfoot","th","thead","time","tr","track","tt","u","ul","var","video","wbr"]),E=s(["svg","a","altglyph","altglyphdef","altglyphitem","animatecolor","animatemotion","animatetransform","circle","clippath","defs","desc","ellipse","filter","font","g","glyph","glyphref","hkern","image","line","lineargradient","marker","mask","metadata","mpath","path","pattern","polygon","polyline","radialgradient","rect","stop","style","switch","symbol","text","textpath","title","tref","tspan","view","vkern"]),N=s(["feBlend","feColorMatrix","feComponentTransfer","feComposite","feConvolveMatrix","feDiffuseLighting","feDisplacementMap","feDistantLight","feFlood","feFuncA","feFuncB","feFuncG","feFuncR","feGaussianBlur","feMerge","feMergeNode","feMorphology","feOffset","fePointLight","feSpecularLighting","feSpotLight","feTile","feTurbulence"]),Q=s(["animate","color-profile","cursor","discard","fedropshadow","feimage","font-face","font-face-format","font-face-name","font-face-src","font-face-uri","foreignobject","hatch","hatchpath","mesh","meshgradient","meshpatch","meshrow","missing-glyph","script","set","solidcolor","unknown","use"]),F=s(["math","menclose","merror","mfenced","mfrac","mglyph","mi","mlabeledtr","mmultiscripts","mn","mo","mover","mpadded","mphantom","mroot","mrow","ms","mspace","msqrt","mstyle","msub","msup","msubsup","mtable","mtd","mtext","mtr","munder","munderover"]),U=s(["maction","maligngroup","malignmark","mlongdiv","mscarries","mscarry","msgroup","mstack","msline","msrow","semantics","annotation","annotation-xml","mprescripts","none"]),S=s(["#text"]),L=s(["accept","action","align","alt","autocapitalize","autocomplete","autopictureinpicture","autoplay","background","bgcolor","border","capture","cellpadding","cellspacing","checked","cite","class","clear","color","cols","colspan","controls","controlslist","coords","crossorigin","datetime","decoding","default","dir","disabled","disablepictureinpicture","disableremoteplayback","download","draggable","enctype","enterkeyhint","face","for","headers","height","hidden","high","href","hreflang","id","inputmode","integrity","ismap","kind","label","lang","list","loading","loop","low","max","maxlength","media","method","min","minlength","multiple","muted","name","noshade","novalidate","nowrap","open","optimum","pattern","placeholder","playsinline","poster","preload","pubdate","radiogroup","readonly","rel","required","rev","reversed","role","rows","rowspan","spellcheck","scope","selected","shape","size","sizes","span","srclang","start","src","srcset","step","style","summary","tabindex","title","translate","type","usemap","valign","value","width","xmlns","slot"]),T=s(["accent-height","accumulate","additive","alignment-baseline","ascent","attributename","attributetype","azimuth","basefrequency","baseline-shift","begin","bias","by","class","clip","clippathunits","clip-path","clip-rule","color","color-interpolation","color-interpolation-filters","color-profile","color-rendering","cx","cy","d","dx","dy","diffuseconstant","direction","display","divisor","dur","edgemode","elevation","end","fill","fill-opacity","fill-rule","filter","filterunits","flood-color","flood-opacity","font-family","font-size","font-size-adjust","font-stretch","font-style","font-variant","font-weight","fx","fy","g1","g2","glyph-name","glyphref","gradientunits","gradienttransform","height","href","id","image-rendering","in","in2","k","k1","k2","k3","k4","kerning","keypoints","keysplines","keytimes","lang","lengthadjust","letter-spacing","kernelmatrix","kernelunitlength","lighting-color","local","marker-end","marker-mid","marker-start","markerheight","markerunits","markerwidth","maskcontentunits","maskunits","max","mask","media","method","mode","min","name","numoctaves","offset","operator","opacity","order","orient","orientation","origin","overflow","paint-order","path","pathlength","patterncontentunits","patterntransform","patternunits","points","preservealpha","preserveaspectratio","primitiveunits","r","rx","ry","radius","refx","refy","repeatcount","repeatdur","restart","result","rotate","scale","seed","shape-rendering","specularconstant","specularexponent","spreadmethod","startoffset","stddeviation","stitchtiles","stop-color","stop-opacity","stroke-dasharray","stroke-dashoffset","stroke-linecap","stroke-linejoin","stroke-miterlimit","stroke-opacity","stroke","stroke-width","style","surfacescale","systemlanguage","tabindex","targetx","targety","transform","text-anchor","text-decoration","text-rendering","textlength","type","u1","u2","unicode","values","viewbox","visibility","version","vert-adv-y","vert-origin-x","vert-origin-y","width","word-spacing","wrap","writing-mode","xchannelselector","ychannelselector","x","x1","x2","xmlns","y","y1","y2","z","zoomandpan"]),H=s(["accent","accentunder","align","bevelled","close","columnsalign","columnlines","columnspan","denomalign","depth","dir","display","displaystyle","encoding","fence","frame","height","href","id","largeop","length","linethickness","lspace","lquote","mathbackground","mathcolor","mathsize","mathvariant","maxsize","minsize","movablelimits","notation","numalign","open","rowalign","rowlines","rowspacing","rowspan","rspace","rquote","scriptlevel","scriptminsize","scriptsizemultiplier","selection","separator","separators","stretchy","subscriptshift","supscriptshift","symmetric","voffset","width","xmlns"]),I=s(["xlink:href","xml:id","xlink:title","xml:space","xmlns:xlink"]),P=i(/\{\{[\s\S]*|[\s\S]*\}\}/gm),O=i(/<%[\s\S]*|[\s\S]*%>/gm),k=i(/^data-[\-\w.\u00B7-\uFFFF]/),R=i(/^aria-[\-\w]+$/),M=i(/^(?:(?:(?:f|ht)tps?|mailto|tel|callto|cid|xmpp):|[^a-z]|[a-z+.\-]+(?:[^a-z+.\-:]|$))/i),D=i(/^(?:\w+script|data):/i),K=i(/[\u0000-\u0020\u00A0\u1680\u180E\u2000-\u2029\u205F\u3000]/g),z="function"==typeof Symbol&&"symbol"==typeof Symbol.iterator?function(e){return typeof e}:function(e){return e&&"function"==typeof Symbol&&e.constructor===Symbol&&e!==Symbol.prototype?"symbol":typeof e};function V(e){if(Array.isArray(e)){for(var t=0,r=Array(e.length);t<e.length;t++)r[t]=e[t];return r}return Array.from(e)}var q=function(){return"undefined"==typeof window?null:window},G=function(e,t){if("object"!==(void 0===e?"undefined":z(e))||"function"!=typeof e.createPolicy)return null;var r=null,n="data-tt-policy-suffix";t.currentScript&&t.currentScript.hasAttribute(n)&&(r=t.currentScript.getAttribute(n));var o="dompurify"+(r?"#"+r:"");try{return e.createPolicy(o,{createHTML:function(e){return e}})}catch(e){return console.warn("TrustedTypes policy "+o+" could not be created."),null}};return function e(){var t=arguments.length>0&&void 0!==arguments[0]?arguments[0]:q(),r=function(t){return e(t)};if(r.version="2.3.0",r.removed=[],!t||!t.document||9!==t.document.nodeType)return r.isSupported=!1,r;var n=t.document,o=t.document,i=t.DocumentFragment,a=t.HTMLTemplateElement,A=t.Node,u=t.Element,c=t.NodeFilter,l=t.NamedNodeMap,B=void 0===l?t.NamedNodeMap||t.MozNamedAttrMap:l,X=t.Text,W=t.Comment,J=t.DOMParser,Y=t.trustedTypes,Z=u.prototype,$=C(Z,"cloneNode"),ee=C(Z,"nextSibling"),te=C(Z,"childNodes"),re=C(Z,"parentNode");if("function"==typeof a){var ne=o.createElement("template");ne.content&&ne.content.ownerDocument&&(o=ne.content.ownerDocument)}var oe=G(Y,n),se=oe&&Pe?oe.createHTML(""):"",ie=o,ae=ie.implementation,Ae=ie.createNodeIterator,ue=ie.createDocumentFragment,ce=ie.getElementsByTagName,le=n.importNode,de={};try{de=_(o).documentMode?o.documentMode:{}}catch(e){}var fe={};r.isSupported="function"==typeof re&&ae&&void 0!==ae.createHTMLDocument&&9!==de;var he=P,pe=O,me=k,ge=R,ye=D,ve=K,we=M,be=null,Be=j({},[].concat(V(x),V(E),V(N),V(F),V(S))),je=null,_e=j({},[].concat(V(L),V(T),V(H),V(I))),Ce=null,xe=null,Ee=!0,Ne=!0,Qe=!1,Fe=!1,Ue=!1,Se=!1,Le=!1,Te=!1,He=!1,Ie=!0,Pe=!1,Oe=!0,ke=!0,Re=!1,Me={},De=j({},["annotation-xml","audio","colgroup","desc","foreignobject","head","iframe","math","mi","mn","mo","ms","mtext","noembed","noframes","noscript","plaintext","script","style","svg","template","thead","title","video","xmp"]),Ke=null,ze=j({},["audio","video","img","source","image","track"]),Ve=null,qe=j({},["alt","class","for","id","label","name","pattern","placeholder","summary","title","value","style","xmlns"]),Ge="http://www.w3.org/1998/Math/MathML",Xe="http://www.w3.org/2000/svg",We="http://www.w3.org/1999/xhtml",Je=We,Ye=!1,Ze=null,$e=o.createElement("form"),et=function(e){Ze&&Ze===e||(e&&"object"===(void 0===e?"undefined":z(e))||(e={}),e=_(e),be="ALLOWED_TAGS"in e?j({},e.ALLOWED_TAGS):Be,je="ALLOWED_ATTR"in e?j({},e.ALLOWED_ATTR):_e,Ve="ADD_URI_SAFE_ATTR"in e?j(_(qe),e.ADD_URI_SAFE_ATTR):qe,Ke="ADD_DATA_URI_TAGS"in e?j(_(ze),e.ADD_DATA_URI_TAGS):ze,Ce="FORBID_TAGS"in e?j({},e.FORBID_TAGS):{},xe="FORBID_ATTR"in e?j({},e.FORBID_ATTR):{},Me="USE_PROFILES"in e&&e.USE_PROFILES,Ee=!1!==e.ALLOW_ARIA_ATTR,Ne=!1!==e.ALLOW_DATA_ATTR,Qe=e.ALLOW_UNKNOWN_PROTOCOLS||!1,Fe=e.SAFE_FOR_TEMPLATES||!1,Ue=e.WHOLE_DOCUMENT||!1,Te=e.RETURN_DOM||!1,He=e.RETURN_DOM_FRAGMENT||!1,Ie=!1!==e.RETURN_DOM_IMPORT,Pe=e.RETURN_TRUSTED_TYPE||!1,Le=e.FORCE_BODY||!1,Oe=!1!==e.SANITIZE_DOM,ke=!1!==e.KEEP_CONTENT,Re=e.IN_PLACE||!1,we=e.ALLOWED_URI_REGEXP||we,Je=e.NAMESPACE||We,Fe&&(Ne=!1),He&&(Te=!0),Me&&(be=j({},[].concat(V(S))),je=[],!0===Me.html&&(j(be,x),j(je,L)),!0===Me.svg&&(j(be,E),j(je,T),j(je,I)),!0===Me.svgFilters&&(j(be,N),j(je,T),j(je,I)),!0===Me.mathMl&&(j(be,F),j(je,H),j(je,I))),e.ADD_TAGS&&(be===Be&&(be=_(be)),j(be,e.ADD_TAGS)),e.ADD_ATTR&&(je===_e&&(je=_(je)),j(je,e.ADD_ATTR)),e.ADD_URI_SAFE_ATTR&&j(Ve,e.ADD_URI_SAFE_ATTR),ke&&(be["#text"]=!0),Ue&&j(be,["html","head","body"]),be.table&&(j(be,["tbody"]),delete Ce.tbody),s&&s(e),Ze=e)},tt=j({},["mi","mo","mn","ms","mtext"]),rt=j({},["foreignobject","desc","title","annotation-xml"]),nt=j({},E);j(nt,N),j(nt,Q);var ot=j({},F);j(ot,U);var st=function(e){var t=re(e);t&&t.tagName||(t={namespaceURI:We,tagName:"template"});var r=p(e.tagName),n=p(t.tagName);if(e.namespaceURI===Xe)return t.namespaceURI===We?"svg"===r:t.namespaceURI===Ge?"svg"===r&&("annotation-xml"===n||tt[n]):Boolean(nt[r]);if(e.namespaceURI===Ge)return t.namespaceURI===We?"math"===r:t.namespaceURI===Xe?"math"===r&&rt[n]:Boolean(ot[r]);if(e.namespaceURI===We){if(t.namespaceURI===Xe&&!rt[n])return!1;if(t.namespaceURI===Ge&&!tt[n])return!1;var o=j({},["title","style","font","a","script"]);return!ot[r]&&(o[r]||!nt[r])}return!1},it=function(e){h(r.removed,{element:e});try{e.parentNode.removeChild(e)}catch(t){try{e.outerHTML=se}catch(t){e.remove()}}},at=function(e,t){try{h(r.removed,{attribute:t.getAttributeNode(e),from:t})}catch(e){h(r.removed,{attribute:null,from:t})}if(t.removeAttribute(e),"is"===e&&!je[e])if(Te||He)try{it(t)}catch(e){}else try{t.setAttribute(e,"")}catch(e){}},At=function(e){var t=void 0,r=void 0;if(Le)e="<remove></remove>"+e;else{var n=m(e,/^[\r\n\t ]+/);r=n&&n[0]}var s=oe?oe.createHTML(e):e;if(Je===We)try{t=(new J).parseFromString(s,"text/html")}catch(e){}if(!t||!t.documentElement){t=ae.createDocument(Je,"template",null);try{t.documentElement.innerHTML=Ye?"":s}catch(e){}}var i=t.body||t.documentElement;return e&&r&&i.insertBefore(o.createTextNode(r),i.childNodes[0]||null),Je===We?ce.call(t,Ue?"html":"body")[0]:Ue?t.documentElement:i},ut=function(e){return Ae.call(e.ownerDocument||e,e,c.SHOW_ELEMENT|c.SHOW_COMMENT|c.SHOW_TEXT,null,!1)},ct=function(e){return!(e instanceof X||e instanceof W||"string"==typeof e.nodeName&&"string"==typeof e.textContent&&"function"==typeof e.removeChild&&e.attributes instanceof B&&"function"==typeof e.removeAttribute&&"function"==typeof e.setAttribute&&"string"==typeof e.namespaceURI&&"function"==typeof e.insertBefore)},lt=function(e){return"object"===(void 0===A?"undefined":z(A))?e instanceof A:e&&"object"===(void 0===e?"undefined":z(e))&&"number"==typeof e.nodeType&&"string"==typeof e.nodeName},dt=function(e,t,n){fe[e]&&d(fe[e],(function(e){e.call(r,t,n,Ze)}))},ft=function(e){var t=void 0;if(dt("beforeSanitizeElements",e,null),ct(e))return it(e),!0;if(m(e.nodeName,/[\u0080-\uFFFF]/))return it(e),!0;var n=p(e.nodeName);if(dt("uponSanitizeElement",e,{tagName:n,allowedTags:be}),!lt(e.firstElementChild)&&(!lt(e.content)||!lt(e.content.firstElementChild))&&w(/<[/\w]/g,e.innerHTML)&&w(/<[/\w]/g,e.textContent))return it(e),!0;if(!be[n]||Ce[n]){if(ke&&!De[n]){var o=re(e)||e.parentNode,s=te(e)||e.childNodes;if(s&&o)for(var i=s.length-1;i>=0;--i)o.insertBefore($(s[i],!0),ee(e))}return it(e),!0}return e instanceof u&&!st(e)?(it(e),!0):"noscript"!==n&&"noembed"!==n||!w(/<\/no(script|embed)/i,e.innerHTML)?(Fe&&3===e.nodeType&&(t=e.textContent,t=g(t,he," "),t=g(t,pe," "),e.textContent!==t&&(h(r.removed,{element:e.cloneNode()}),e.textContent=t)),dt("afterSanitizeElements",e,null),!1):(it(e),!0)},ht=function(e,t,r){if(Oe&&("id"===t||"name"===t)&&(r in o||r in $e))return!1;if(Ne&&!xe[t]&&w(me,t));else if(Ee&&w(ge,t));else{if(!je[t]||xe[t])return!1;if(Ve[t]);else if(w(we,g(r,ve,"")));else if("src"!==t&&"xlink:href"!==t&&"href"!==t||"script"===e||0!==y(r,"data:")||!Ke[e])if(Qe&&!w(ye,g(r,ve,"")));else if(r)return!1}return!0},pt=function(e){var t=void 0,n=void 0,o=void 0,s=void 0;dt("beforeSanitizeAttributes",e,null);var i=e.attributes;if(i){var a={attrName:"",attrValue:"",keepAttr:!0,allowedAttributes:je};for(s=i.length;s--;){var A=t=i[s],u=A.name,c=A.namespaceURI;if(n=v(t.value),o=p(u),a.attrName=o,a.attrValue=n,a.keepAttr=!0,a.forceKeepAttr=void 0,dt("uponSanitizeAttribute",e,a),n=a.attrValue,!a.forceKeepAttr&&(at(u,e),a.keepAttr))if(w(/\/>/i,n))at(u,e);else{Fe&&(n=g(n,he," "),n=g(n,pe," "));var l=e.nodeName.toLowerCase();if(ht(l,o,n))try{c?e.setAttributeNS(c,u,n):e.setAttribute(u,n),f(r.removed)}catch(e){}}}dt("afterSanitizeAttributes",e,null)}},mt=function e(t){var r=void 0,n=ut(t);for(dt("beforeSanitizeShadowDOM",t,null);r=n.nextNode();)dt("uponSanitizeShadowNode",r,null),ft(r)||(r.content instanceof i&&e(r.content),pt(r));dt("afterSanitizeShadowDOM",t,null)};return r.sanitize=function(e,o){var s=void 0,a=void 0,u=void 0,c=void 0,l=void 0;if((Ye=!e)&&(e="\x3c!--\x3e"),"string"!=typeof e&&!lt(e)){if("function"!=typeof e.toString)throw b("toString is not a function");if("string"!=typeof(e=e.toString()))throw b("dirty is not a string, aborting")}if(!r.isSupported){if("object"===z(t.toStaticHTML)||"function"==typeof t.toStaticHTML){if("string"==typeof e)return t.toStaticHTML(e);if(lt(e))return t.toStaticHTML(e.outerHTML)}return e}if(Se||et(o),r.removed=[],"string"==typeof e&&(Re=!1),Re);else if(e instanceof A)1===(a=(s=At("\x3c!----\x3e")).ownerDocument.importNode(e,!0)).nodeType&&"BODY"===a.nodeName||"HTML"===a.nodeName?s=a:s.appendChild(a);else{if(!Te&&!Fe&&!Ue&&-1===e.indexOf("<"))return oe&&Pe?oe.createHTML(e):e;if(!(s=At(e)))return Te?null:se}s&&Le&&it(s.firstChild);for(var d=ut(Re?e:s);u=d.nextNode();)3===u.nodeType&&u===c||ft(u)||(u.content instanceof i&&mt(u.content),pt(u),c=u);if(c=null,Re)return e;if(Te){if(He)for(l=ue.call(s.ownerDocument);s.firstChild;)l.appendChild(s.firstChild);else l=s;return Ie&&(l=le.call(n,l,!0)),l}var f=Ue?s.outerHTML:s.innerHTML;return Fe&&(f=g(f,he," "),f=g(f,pe," ")),oe&&Pe?oe.createHTML(f):f},r.setConfig=function(e){et(e),Se=!0},r.clearConfig=function(){Ze=null,Se=!1},r.isValidAttribute=function(e,t,r){Ze||et({});var n=p(e),o=p(t);return ht(n,o,r)},r.addHook=function(e,t){"function"==typeof t&&(fe[e]=fe[e]||[],h(fe[e],t))},r.removeHook=function(e){fe[e]&&f(fe[e])},r.removeHooks=function(e){fe[e]&&(fe[e]=[])},r.removeAllHooks=function(){fe={}},r}()}()},"./node_modules/es6-promise/dist/es6-promise.js":function(e){var t;t=function(){"use strict";function e(e){return"function"==typeof e}var t=Array.isArray?Array.isArray:function(e){return"[object Array]"===Object.prototype.toString.call(e)},r=0,n=void 0,o=void 0,s=function(e,t){d[r]=e,d[r+1]=t,2===(r+=2)&&(o?o(f):y())},i="undefined"!=typeof window?window:void 0,a=i||{},A=a.MutationObserver||a.WebKitMutationObserver,u="undefined"==typeof self&&"undefined"!=typeof process&&"[object process]"==={}.toString.call(process),c="undefined"!=typeof Uint8ClampedArray&&"undefined"!=typeof importScripts&&"undefined"!=typeof MessageChannel;function l(){var e=setTimeout;return function(){return e(f,1)}}var d=new Array(1e3);function f(){for(var e=0;e<r;e+=2)(0,d[e])(d[e+1]),d[e]=void 0,d[e+1]=void 0;r=0}var h,p,m,g,y=void 0;function v(e,t){var r=this,n=new this.constructor(B);void 0===n[b]&&L(n);var o=r._state;if(o){var i=arguments[o-1];s((function(){return U(o,n,i,r._result)}))}else Q(r,n,e,t);return n}function w(e){if(e&&"object"==typeof e&&e.constructor===this)return e;var t=new this(B);return C(t,e),t}u?y=function(){return process.nextTick(f)}:A?(p=0,m=new A(f),g=document.createTextNode(""),m.observe(g,{characterData:!0}),y=function(){g.data=p=++p%2}):c?((h=new MessageChannel).port1.onmessage=f,y=function(){return h.port2.postMessage(0)}):y=void 0===i?function(){try{var e=Function("return this")().require("vertx");return void 0!==(n=e.runOnLoop||e.runOnContext)?function(){n(f)}:l()}catch(e){return l()}}():l();var b=Math.random().toString(36).substring(2);function B(){}var j=void 0;function _(t,r,n){r.constructor===t.constructor&&n===v&&r.constructor.resolve===w?function(e,t){1===t._state?E(e,t._result):2===t._state?N(e,t._result):Q(t,void 0,(function(t){return C(e,t)}),(function(t){return N(e,t)}))}(t,r):void 0===n?E(t,r):e(n)?function(e,t,r){s((function(e){var n=!1,o=function(r,o,s,i){try{r.call(o,(function(r){n||(n=!0,t!==r?C(e,r):E(e,r))}),(function(t){n||(n=!0,N(e,t))}))}catch(e){return e}}(r,t,0,0,e._label);!n&&o&&(n=!0,N(e,o))}),e)}(t,r,n):E(t,r)}function C(e,t){if(e===t)N(e,new TypeError("You cannot resolve a promise with itself"));else if(o=typeof(n=t),null===n||"object"!==o&&"function"!==o)E(e,t);else{var r=void 0;try{r=t.then}catch(t){return void N(e,t)}_(e,t,r)}var n,o}function x(e){e._onerror&&e._onerror(e._result),F(e)}function E(e,t){e._state===j&&(e._result=t,e._state=1,0!==e._subscribers.length&&s(F,e))}function N(e,t){e._state===j&&(e._state=2,e._result=t,s(x,e))}function Q(e,t,r,n){var o=e._subscribers,i=o.length;e._onerror=null,o[i]=t,o[i+1]=r,o[i+2]=n,0===i&&e._state&&s(F,e)}function F(e){var t=e._subscribers,r=e._state;if(0!==t.length){for(var n=void 0,o=void 0,s=e._result,i=0;i<t.length;i+=3)n=t[i],o=t[i+r],n?U(r,n,o,s):o(s);e._subscribers.length=0}}function U(t,r,n,o){var s=e(n),i=void 0,a=void 0,A=!0;if(s){try{i=n(o)}catch(e){A=!1,a=e}if(r===i)return void N(r,new TypeError("A promises callback cannot return that same promise."))}else i=o;r._state!==j||(s&&A?C(r,i):!1===A?N(r,a):1===t?E(r,i):2===t&&N(r,i))}var S=0;function L(e){e[b]=S++,e._state=void 0,e._result=void 0,e._subscribers=[]}var T=function(){function e(e,r){this._instanceConstructor=e,this.promise=new e(B),this.promise[b]||L(this.promise),t(r)?(this.length=r.length,this._remaining=r.length,this._result=new Array(this.length),0===this.length?E(this.promise,this._result):(this.length=this.length||0,this._enumerate(r),0===this._remaining&&E(this.promise,this._result))):N(this.promise,new Error("Array Methods must be provided an Array"))}return e.prototype._enumerate=function(e){for(var t=0;this._state===j&&t<e.length;t++)this._eachEntry(e[t],t)},e.prototype._eachEntry=function(e,t){var r=this._instanceConstructor,n=r.resolve;if(n===w){var o=void 0,s=void 0,i=!1;try{o=e.then}catch(e){i=!0,s=e}if(o===v&&e._state!==j)this._settledAt(e._state,t,e._result);else if("function"!=typeof o)this._remaining--,this._result[t]=e;else if(r===H){var a=new r(B);i?N(a,s):_(a,e,o),this._willSettleAt(a,t)}else this._willSettleAt(new r((function(t){return t(e)})),t)}else this._willSettleAt(n(e),t)},e.prototype._settledAt=function(e,t,r){var n=this.promise;n._state===j&&(this._remaining--,2===e?N(n,r):this._result[t]=r),0===this._remaining&&E(n,this._result)},e.prototype._willSettleAt=function(e,t){var r=this;Q(e,void 0,(function(e){return r._settledAt(1,t,e)}),(function(e){return r._settledAt(2,t,e)}))},e}(),H=function(){function t(e){this[b]=S++,this._result=this._state=void 0,this._subscribers=[],B!==e&&("function"!=typeof e&&function(){throw new TypeError("You must pass a resolver function as the first argument to the promise constructor")}(),this instanceof t?function(e,t){try{t((function(t){C(e,t)}),(function(t){N(e,t)}))}catch(t){N(e,t)}}(this,e):function(){throw new TypeError("Failed to construct 'Promise': Please use the 'new' operator, this object constructor cannot be called as a function.")}())}return t.prototype.catch=function(e){return this.then(null,e)},t.prototype.finally=function(t){var r=this,n=r.constructor;return e(t)?r.then((function(e){return n.resolve(t()).then((function(){return e}))}),(function(e){return n.resolve(t()).then((function(){throw e}))})):r.then(t,t)},t}();return H.prototype.then=v,H.all=function(e){return new T(this,e).promise},H.race=function(e){var r=this;return t(e)?new r((function(t,n){for(var o=e.length,s=0;s<o;s++)r.resolve(e[s]).then(t,n)})):new r((function(e,t){return t(new TypeError("You must pass an array to race."))}))},H.resolve=w,H.reject=function(e){var t=new this(B);return N(t,e),t},H._setScheduler=function(e){o=e},H._setAsap=function(e){s=e},H._asap=s,H.polyfill=function(){var e=void 0;if("undefined"!=typeof global)e=global;else if("undefined"!=typeof self)e=self;else try{e=Function("return this")()}catch(e){throw new Error("polyfill failed because global object is unavailable in this environment")}var t=e.Promise;if(t){var r=null;try{r=Object.prototype.toString.call(t.resolve())}catch(e){}if("[object Promise]"===r&&!t.cast)return}e.Promise=H},H.Promise=H,H},e.exports=t()},"./node_modules/fflate/esm/browser.js":function(e,t,r){"use strict";r.r(t),r.d(t,{Deflate:function(){return ve},AsyncDeflate:function(){return we},deflate:function(){return be},deflateSync:function(){return Be},Inflate:function(){return je},AsyncInflate:function(){return _e},inflate:function(){return Ce},inflateSync:function(){return xe},Gzip:function(){return Ee},AsyncGzip:function(){return Ne},gzip:function(){return Qe},gzipSync:function(){return Fe},Gunzip:function(){return Ue},AsyncGunzip:function(){return Se},gunzip:function(){return Le},gunzipSync:function(){return Te},Zlib:function(){return He},AsyncZlib:function(){return Ie},zlib:function(){return Pe},zlibSync:function(){return Oe},Unzlib:function(){return ke},AsyncUnzlib:function(){return Re},unzlib:function(){return Me},unzlibSync:function(){return De},compress:function(){return Qe},AsyncCompress:function(){return Ne},compressSync:function(){return Fe},Compress:function(){return Ee},Decompress:function(){return Ke},AsyncDecompress:function(){return ze},decompress:function(){return Ve},decompressSync:function(){return qe},strToU8:function(){return Xe},strFromU8:function(){return We},zip:function(){return tt},zipSync:function(){return rt},unzip:function(){return nt},unzipSync:function(){return ot}});var n={},o=Uint8Array,s=Uint16Array,i=Uint32Array,a=new o([0,0,0,0,0,0,0,0,1,1,1,1,2,2,2,2,3,3,3,3,4,4,4,4,5,5,5,5,0,0,0,0]),A=new o([0,0,0,0,1,1,2,2,3,3,4,4,5,5,6,6,7,7,8,8,9,9,10,10,11,11,12,12,13,13,0,0]),u=new o([16,17,18,0,8,7,9,6,10,5,11,4,12,3,13,2,14,1,15]),c=function(e,t){for(var r=new s(31),n=0;n<31;++n)r[n]=t+=1<<e[n-1];var o=new i(r[30]);for(n=1;n<30;++n)for(var a=r[n];a<r[n+1];++a)o[a]=a-r[n]<<5|n;return[r,o]},l=c(a,2),d=l[0],f=l[1];d[28]=258,f[258]=28;for(var h=c(A,0),p=h[0],m=h[1],g=new s(32768),y=0;y<32768;++y){var v=(43690&y)>>>1|(21845&y)<<1;v=(61680&(v=(52428&v)>>>2|(13107&v)<<2))>>>4|(3855&v)<<4,g[y]=((65280&v)>>>8|(255&v)<<8)>>>1}var w=function(e,t,r){for(var n=e.length,o=0,i=new s(t);o<n;++o)++i[e[o]-1];var a,A=new s(t);for(o=0;o<t;++o)A[o]=A[o-1]+i[o-1]<<1;if(r){a=new s(1<<t);var u=15-t;for(o=0;o<n;++o)if(e[o])for(var c=o<<4|e[o],l=t-e[o],d=A[e[o]-1]++<<l,f=d|(1<<l)-1;d<=f;++d)a[g[d]>>>u]=c}else for(a=new s(n),o=0;o<n;++o)a[o]=g[A[e[o]-1]++]>>>15-e[o];return a},b=new o(288);for(y=0;y<144;++y)b[y]=8;for(y=144;y<256;++y)b[y]=9;for(y=256;y<280;++y)b[y]=7;for(y=280;y<288;++y)b[y]=8;var B=new o(32);for(y=0;y<32;++y)B[y]=5;var j=w(b,9,0),_=w(b,9,1),C=w(B,5,0),x=w(B,5,1),E=function(e){for(var t=e[0],r=1;r<e.length;++r)e[r]>t&&(t=e[r]);return t},N=function(e,t,r){var n=t/8>>0;return(e[n]|e[n+1]<<8)>>>(7&t)&r},Q=function(e,t){var r=t/8>>0;return(e[r]|e[r+1]<<8|e[r+2]<<16)>>>(7&t)},F=function(e){return(e/8>>0)+(7&e&&1)},U=function(e,t,r){(null==t||t<0)&&(t=0),(null==r||r>e.length)&&(r=e.length);var n=new(e instanceof s?s:e instanceof i?i:o)(r-t);return n.set(e.subarray(t,r)),n},S=function(e,t,r){var n=e.length,s=!t||r,i=!r||r.i;r||(r={}),t||(t=new o(3*n));var c=function(e){var r=t.length;if(e>r){var n=new o(Math.max(2*r,e));n.set(t),t=n}},l=r.f||0,f=r.p||0,h=r.b||0,m=r.l,g=r.d,y=r.m,v=r.n,b=8*n;do{if(!m){r.f=l=N(e,f,1);var B=N(e,f+1,3);if(f+=3,!B){var j=e[(M=F(f)+4)-4]|e[M-3]<<8,C=M+j;if(C>n){if(i)throw"unexpected EOF";break}s&&c(h+j),t.set(e.subarray(M,C),h),r.b=h+=j,r.p=f=8*C;continue}if(1==B)m=_,g=x,y=9,v=5;else{if(2!=B)throw"invalid block type";var S=N(e,f,31)+257,L=N(e,f+10,15)+4,T=S+N(e,f+5,31)+1;f+=14;for(var H=new o(T),I=new o(19),P=0;P<L;++P)I[u[P]]=N(e,f+3*P,7);f+=3*L;var O=E(I),k=(1<<O)-1;if(!i&&f+T*(O+7)>b)break;var R=w(I,O,1);for(P=0;P<T;){var M,D=R[N(e,f,k)];if(f+=15&D,(M=D>>>4)<16)H[P++]=M;else{var K=0,z=0;for(16==M?(z=3+N(e,f,3),f+=2,K=H[P-1]):17==M?(z=3+N(e,f,7),f+=3):18==M&&(z=11+N(e,f,127),f+=7);z--;)H[P++]=K}}var V=H.subarray(0,S),q=H.subarray(S);y=E(V),v=E(q),m=w(V,y,1),g=w(q,v,1)}if(f>b)throw"unexpected EOF"}s&&c(h+131072);for(var G=(1<<y)-1,X=(1<<v)-1,W=y+v+18;i||f+W<b;){var J=(K=m[Q(e,f)&G])>>>4;if((f+=15&K)>b)throw"unexpected EOF";if(!K)throw"invalid length/literal";if(J<256)t[h++]=J;else{if(256==J){m=null;break}var Y=J-254;if(J>264){var Z=a[P=J-257];Y=N(e,f,(1<<Z)-1)+d[P],f+=Z}var $=g[Q(e,f)&X],ee=$>>>4;if(!$)throw"invalid distance";if(f+=15&$,q=p[ee],ee>3&&(Z=A[ee],q+=Q(e,f)&(1<<Z)-1,f+=Z),f>b)throw"unexpected EOF";s&&c(h+131072);for(var te=h+Y;h<te;h+=4)t[h]=t[h-q],t[h+1]=t[h+1-q],t[h+2]=t[h+2-q],t[h+3]=t[h+3-q];h=te}}r.l=m,r.p=f,r.b=h,m&&(l=1,r.m=y,r.d=g,r.n=v)}while(!l);return h==t.length?t:U(t,0,h)},L=function(e,t,r){r<<=7&t;var n=t/8>>0;e[n]|=r,e[n+1]|=r>>>8},T=function(e,t,r){r<<=7&t;var n=t/8>>0;e[n]|=r,e[n+1]|=r>>>8,e[n+2]|=r>>>16},H=function(e,t){for(var r=[],n=0;n<e.length;++n)e[n]&&r.push({s:n,f:e[n]});var i=r.length,a=r.slice();if(!i)return[new o(0),0];if(1==i){var A=new o(r[0].s+1);return A[r[0].s]=1,[A,1]}r.sort((function(e,t){return e.f-t.f})),r.push({s:-1,f:25001});var u=r[0],c=r[1],l=0,d=1,f=2;for(r[0]={s:-1,f:u.f+c.f,l:u,r:c};d!=i-1;)u=r[r[l].f<r[f].f?l++:f++],c=r[l!=d&&r[l].f<r[f].f?l++:f++],r[d++]={s:-1,f:u.f+c.f,l:u,r:c};var h=a[0].s;for(n=1;n<i;++n)a[n].s>h&&(h=a[n].s);var p=new s(h+1),m=I(r[d-1],p,0);if(m>t){n=0;var g=0,y=m-t,v=1<<y;for(a.sort((function(e,t){return p[t.s]-p[e.s]||e.f-t.f}));n<i;++n){var w=a[n].s;if(!(p[w]>t))break;g+=v-(1<<m-p[w]),p[w]=t}for(g>>>=y;g>0;){var b=a[n].s;p[b]<t?g-=1<<t-p[b]++-1:++n}for(;n>=0&&g;--n){var B=a[n].s;p[B]==t&&(--p[B],++g)}m=t}return[new o(p),m]},I=function(e,t,r){return-1==e.s?Math.max(I(e.l,t,r+1),I(e.r,t,r+1)):t[e.s]=r},P=function(e){for(var t=e.length;t&&!e[--t];);for(var r=new s(++t),n=0,o=e[0],i=1,a=function(e){r[n++]=e},A=1;A<=t;++A)if(e[A]==o&&A!=t)++i;else{if(!o&&i>2){for(;i>138;i-=138)a(32754);i>2&&(a(i>10?i-11<<5|28690:i-3<<5|12305),i=0)}else if(i>3){for(a(o),--i;i>6;i-=6)a(8304);i>2&&(a(i-3<<5|8208),i=0)}for(;i--;)a(o);i=1,o=e[A]}return[r.subarray(0,n),t]},O=function(e,t){for(var r=0,n=0;n<t.length;++n)r+=e[n]*t[n];return r},k=function(e,t,r){var n=r.length,o=F(t+2);e[o]=255&n,e[o+1]=n>>>8,e[o+2]=255^e[o],e[o+3]=255^e[o+1];for(var s=0;s<n;++s)e[o+s+4]=r[s];return 8*(o+4+n)},R=function(e,t,r,n,o,i,c,l,d,f,h){L(t,h++,r),++o[256];for(var p=H(o,15),m=p[0],g=p[1],y=H(i,15),v=y[0],_=y[1],x=P(m),E=x[0],N=x[1],Q=P(v),F=Q[0],U=Q[1],S=new s(19),I=0;I<E.length;++I)S[31&E[I]]++;for(I=0;I<F.length;++I)S[31&F[I]]++;for(var R=H(S,7),M=R[0],D=R[1],K=19;K>4&&!M[u[K-1]];--K);var z,V,q,G,X=f+5<<3,W=O(o,b)+O(i,B)+c,J=O(o,m)+O(i,v)+c+14+3*K+O(S,M)+(2*S[16]+3*S[17]+7*S[18]);if(X<=W&&X<=J)return k(t,h,e.subarray(d,d+f));if(L(t,h,1+(J<W)),h+=2,J<W){z=w(m,g,0),V=m,q=w(v,_,0),G=v;var Y=w(M,D,0);for(L(t,h,N-257),L(t,h+5,U-1),L(t,h+10,K-4),h+=14,I=0;I<K;++I)L(t,h+3*I,M[u[I]]);h+=3*K;for(var Z=[E,F],$=0;$<2;++$){var ee=Z[$];for(I=0;I<ee.length;++I){var te=31&ee[I];L(t,h,Y[te]),h+=M[te],te>15&&(L(t,h,ee[I]>>>5&127),h+=ee[I]>>>12)}}}else z=j,V=b,q=C,G=B;for(I=0;I<l;++I)if(n[I]>255){te=n[I]>>>18&31,T(t,h,z[te+257]),h+=V[te+257],te>7&&(L(t,h,n[I]>>>23&31),h+=a[te]);var re=31&n[I];T(t,h,q[re]),h+=G[re],re>3&&(T(t,h,n[I]>>>5&8191),h+=A[re])}else T(t,h,z[n[I]]),h+=V[n[I]];return T(t,h,z[256]),h+V[256]},M=new i([65540,131080,131088,131104,262176,1048704,1048832,2114560,2117632]),D=new o(0),K=function(e,t,r,n,u,c){var l=e.length,d=new o(n+l+5*(1+Math.floor(l/7e3))+u),h=d.subarray(n,d.length-u),p=0;if(!t||l<8)for(var g=0;g<=l;g+=65535){var y=g+65535;y<l?p=k(h,p,e.subarray(g,y)):(h[g]=c,p=k(h,p,e.subarray(g,l)))}else{for(var v=M[t-1],w=v>>>13,b=8191&v,B=(1<<r)-1,j=new s(32768),_=new s(B+1),C=Math.ceil(r/3),x=2*C,E=function(t){return(e[t]^e[t+1]<<C^e[t+2]<<x)&B},N=new i(25e3),Q=new s(288),S=new s(32),L=0,T=0,H=(g=0,0),I=0,P=0;g<l;++g){var O=E(g),K=32767&g,z=_[O];if(j[K]=z,_[O]=K,I<=g){var V=l-g;if((L>7e3||H>24576)&&V>423){p=R(e,h,0,N,Q,S,T,H,P,g-P,p),H=L=T=0,P=g;for(var q=0;q<286;++q)Q[q]=0;for(q=0;q<30;++q)S[q]=0}var G=2,X=0,W=b,J=K-z&32767;if(V>2&&O==E(g-J))for(var Y=Math.min(w,V)-1,Z=Math.min(32767,g),$=Math.min(258,V);J<=Z&&--W&&K!=z;){if(e[g+G]==e[g+G-J]){for(var ee=0;ee<$&&e[g+ee]==e[g+ee-J];++ee);if(ee>G){if(G=ee,X=J,ee>Y)break;var te=Math.min(J,ee-2),re=0;for(q=0;q<te;++q){var ne=g-J+q+32768&32767,oe=ne-j[ne]+32768&32767;oe>re&&(re=oe,z=ne)}}}J+=(K=z)-(z=j[K])+32768&32767}if(X){N[H++]=268435456|f[G]<<18|m[X];var se=31&f[G],ie=31&m[X];T+=a[se]+A[ie],++Q[257+se],++S[ie],I=g+G,++L}else N[H++]=e[g],++Q[e[g]]}}p=R(e,h,c,N,Q,S,T,H,P,g-P,p),c||(p=k(h,p,D))}return U(d,0,n+F(p)+u)},z=function(){for(var e=new i(256),t=0;t<256;++t){for(var r=t,n=9;--n;)r=(1&r&&3988292384)^r>>>1;e[t]=r}return e}(),V=function(){var e=4294967295;return{p:function(t){for(var r=e,n=0;n<t.length;++n)r=z[255&r^t[n]]^r>>>8;e=r},d:function(){return 4294967295^e}}},q=function(){var e=1,t=0;return{p:function(r){for(var n=e,o=t,s=r.length,i=0;i!=s;){for(var a=Math.min(i+5552,s);i<a;++i)o+=n+=r[i];n%=65521,o%=65521}e=n,t=o},d:function(){return(e>>>8<<16|(255&t)<<8|t>>>8)+2*((255&e)<<23)}}},G=function(e,t,r,n,o){return K(e,null==t.level?6:t.level,null==t.mem?Math.ceil(1.5*Math.max(8,Math.min(13,Math.log(e.length)))):12+t.mem,r,n,!o)},X=function(e,t){var r={};for(var n in e)r[n]=e[n];for(var n in t)r[n]=t[n];return r},W=function(e,t,r){for(var n=e(),o=e.toString(),s=o.slice(o.indexOf("[")+1,o.lastIndexOf("]")).replace(/ /g,"").split(","),i=0;i<n.length;++i){var a=n[i],A=s[i];if("function"==typeof a){t+=";"+A+"=";var u=a.toString();if(a.prototype)if(-1!=u.indexOf("[native code]")){var c=u.indexOf(" ",8)+1;t+=u.slice(c,u.indexOf("(",c))}else for(var l in t+=u,a.prototype)t+=";"+A+".prototype."+l+"="+a.prototype[l].toString();else t+=u}else r[A]=a}return[t,r]},J=[],Y=function(e,t,r,a){var A;if(!J[r]){for(var u="",c={},l=e.length-1,d=0;d<l;++d)u=(A=W(e[d],u,c))[0],c=A[1];J[r]=W(e[l],u,c)}var f=X({},J[r][1]);return function(e,t,r,o,s){var i=n[t]||(n[t]=URL.createObjectURL(new Blob([e],{type:"text/javascript"}))),a=new Worker(i);return a.onerror=function(e){return s(e.error,null)},a.onmessage=function(e){return s(null,e.data)},a.postMessage(r,o),a}(J[r][0]+";onmessage=function(e){for(var k in e.data)self[k]=e.data[k];onmessage="+t.toString()+"}",r,f,function(e){var t=[];for(var r in e)(e[r]instanceof o||e[r]instanceof s||e[r]instanceof i)&&t.push((e[r]=new e[r].constructor(e[r])).buffer);return t}(f),a)},Z=function(){return[o,s,i,a,A,u,d,p,_,x,g,w,E,N,Q,F,U,S,xe,oe,se]},$=function(){return[o,s,i,a,A,u,f,m,j,b,C,B,g,M,D,w,L,T,H,I,P,O,k,R,F,U,K,G,Be,oe]},ee=function(){return[de,pe,le,V,z]},te=function(){return[fe,he]},re=function(){return[me,le,q]},ne=function(){return[ge]},oe=function(e){return postMessage(e,[e.buffer])},se=function(e){return e&&e.size&&new o(e.size)},ie=function(e,t,r,n,s,i){var a=Y(r,n,s,(function(e,t){a.terminate(),i(e,t)}));return t.consume||(e=new o(e)),a.postMessage([e,t],[e.buffer]),function(){a.terminate()}},ae=function(e){return e.ondata=function(e,t){return postMessage([e,t],[e.buffer])},function(t){return e.push(t.data[0],t.data[1])}},Ae=function(e,t,r,n,o){var s,i=Y(e,n,o,(function(e,r){e?(i.terminate(),t.ondata.call(t,e)):(r[1]&&i.terminate(),t.ondata.call(t,e,r[0],r[1]))}));i.postMessage(r),t.push=function(e,r){if(s)throw"stream finished";if(!t.ondata)throw"no stream handler";i.postMessage([e,s=r],[e.buffer])},t.terminate=function(){i.terminate()}},ue=function(e,t){return e[t]|e[t+1]<<8},ce=function(e,t){return(e[t]|e[t+1]<<8|e[t+2]<<16)+2*(e[t+3]<<23)},le=function(e,t,r){for(;r;++t)e[t]=r,r>>>=8},de=function(e,t){var r=t.filename;if(e[0]=31,e[1]=139,e[2]=8,e[8]=t.level<2?4:9==t.level?2:0,e[9]=3,0!=t.mtime&&le(e,4,Math.floor(new Date(t.mtime||Date.now())/1e3)),r){e[3]=8;for(var n=0;n<=r.length;++n)e[n+10]=r.charCodeAt(n)}},fe=function(e){if(31!=e[0]||139!=e[1]||8!=e[2])throw"invalid gzip data";var t=e[3],r=10;4&t&&(r+=e[10]|2+(e[11]<<8));for(var n=(t>>3&1)+(t>>4&1);n>0;n-=!e[r++]);return r+(2&t)},he=function(e){var t=e.length;return(e[t-4]|e[t-3]<<8|e[t-2]<<16)+2*(e[t-1]<<23)},pe=function(e){return 10+(e.filename&&e.filename.length+1||0)},me=function(e,t){var r=t.level,n=0==r?0:r<6?1:9==r?3:2;e[0]=120,e[1]=n<<6|(n?32-2*n:1)},ge=function(e){if(8!=(15&e[0])||e[0]>>>4>7||(e[0]<<8|e[1])%31)throw"invalid zlib data";if(32&e[1])throw"invalid zlib data: preset dictionaries not supported"};function ye(e,t){return t||"function"!=typeof e||(t=e,e={}),this.ondata=t,e}var ve=function(){function e(e,t){t||"function"!=typeof e||(t=e,e={}),this.ondata=t,this.o=e||{}}return e.prototype.p=function(e,t){this.ondata(G(e,this.o,0,0,!t),t)},e.prototype.push=function(e,t){if(this.d)throw"stream finished";if(!this.ondata)throw"no stream handler";this.d=t,this.p(e,t||!1)},e}(),we=function(){return function(e,t){Ae([$,function(){return[ae,ve]}],this,ye.call(this,e,t),(function(e){var t=new ve(e.data);onmessage=ae(t)}),6)}}();function be(e,t,r){if(r||(r=t,t={}),"function"!=typeof r)throw"no callback";return ie(e,t,[$],(function(e){return oe(Be(e.data[0],e.data[1]))}),0,r)}function Be(e,t){return void 0===t&&(t={}),G(e,t,0,0)}var je=function(){function e(e){this.s={},this.p=new o(0),this.ondata=e}return e.prototype.e=function(e){if(this.d)throw"stream finished";if(!this.ondata)throw"no stream handler";var t=this.p.length,r=new o(t+e.length);r.set(this.p),r.set(e,t),this.p=r},e.prototype.c=function(e){this.d=this.s.i=e||!1;var t=this.s.b,r=S(this.p,this.o,this.s);this.ondata(U(r,t,this.s.b),this.d),this.o=U(r,this.s.b-32768),this.s.b=this.o.length,this.p=U(this.p,this.s.p/8>>0),this.s.p&=7},e.prototype.push=function(e,t){this.e(e),this.c(t)},e}(),_e=function(){return function(e){this.ondata=e,Ae([Z,function(){return[ae,je]}],this,0,(function(){var e=new je;onmessage=ae(e)}),7)}}();function Ce(e,t,r){if(r||(r=t,t={}),"function"!=typeof r)throw"no callback";return ie(e,t,[Z],(function(e){return oe(xe(e.data[0],se(e.data[1])))}),1,r)}function xe(e,t){return S(e,t)}var Ee=function(){function e(e,t){this.c=V(),this.l=0,this.v=1,ve.call(this,e,t)}return e.prototype.push=function(e,t){ve.prototype.push.call(this,e,t)},e.prototype.p=function(e,t){this.c.p(e),this.l+=e.length;var r=G(e,this.o,this.v&&pe(this.o),t&&8,!t);this.v&&(de(r,this.o),this.v=0),t&&(le(r,r.length-8,this.c.d()),le(r,r.length-4,this.l)),this.ondata(r,t)},e}(),Ne=function(){return function(e,t){Ae([$,ee,function(){return[ae,ve,Ee]}],this,ye.call(this,e,t),(function(e){var t=new Ee(e.data);onmessage=ae(t)}),8)}}();function Qe(e,t,r){if(r||(r=t,t={}),"function"!=typeof r)throw"no callback";return ie(e,t,[$,ee,function(){return[Fe]}],(function(e){return oe(Fe(e.data[0],e.data[1]))}),2,r)}function Fe(e,t){void 0===t&&(t={});var r=V(),n=e.length;r.p(e);var o=G(e,t,pe(t),8),s=o.length;return de(o,t),le(o,s-8,r.d()),le(o,s-4,n),o}var Ue=function(){function e(e){this.v=1,je.call(this,e)}return e.prototype.push=function(e,t){if(je.prototype.e.call(this,e),this.v){var r=fe(this.p);if(r>=this.p.length&&!t)return;this.p=this.p.subarray(r),this.v=0}if(t){if(this.p.length<8)throw"invalid gzip stream";this.p=this.p.subarray(0,-8)}je.prototype.c.call(this,t)},e}(),Se=function(){return function(e){this.ondata=e,Ae([Z,te,function(){return[ae,je,Ue]}],this,0,(function(){var e=new Ue;onmessage=ae(e)}),9)}}();function Le(e,t,r){if(r||(r=t,t={}),"function"!=typeof r)throw"no callback";return ie(e,t,[Z,te,function(){return[Te]}],(function(e){return oe(Te(e.data[0]))}),3,r)}function Te(e,t){return S(e.subarray(fe(e),-8),t||new o(he(e)))}var He=function(){function e(e,t){this.c=q(),this.v=1,ve.call(this,e,t)}return e.prototype.push=function(e,t){ve.prototype.push.call(this,e,t)},e.prototype.p=function(e,t){this.c.p(e);var r=G(e,this.o,this.v&&2,t&&4,!t);this.v&&(me(r,this.o),this.v=0),t&&le(r,r.length-4,this.c.d()),this.ondata(r,t)},e}(),Ie=function(){return function(e,t){Ae([$,re,function(){return[ae,ve,He]}],this,ye.call(this,e,t),(function(e){var t=new He(e.data);onmessage=ae(t)}),10)}}();function Pe(e,t,r){if(r||(r=t,t={}),"function"!=typeof r)throw"no callback";return ie(e,t,[$,re,function(){return[Oe]}],(function(e){return oe(Oe(e.data[0],e.data[1]))}),4,r)}function Oe(e,t){void 0===t&&(t={});var r=q();r.p(e);var n=G(e,t,2,4);return me(n,t),le(n,n.length-4,r.d()),n}var ke=function(){function e(e){this.v=1,je.call(this,e)}return e.prototype.push=function(e,t){if(je.prototype.e.call(this,e),this.v){if(this.p.length<2&&!t)return;this.p=this.p.subarray(2),this.v=0}if(t){if(this.p.length<4)throw"invalid zlib stream";this.p=this.p.subarray(0,-4)}je.prototype.c.call(this,t)},e}(),Re=function(){return function(e){this.ondata=e,Ae([Z,ne,function(){return[ae,je,ke]}],this,0,(function(){var e=new ke;onmessage=ae(e)}),11)}}();function Me(e,t,r){if(r||(r=t,t={}),"function"!=typeof r)throw"no callback";return ie(e,t,[Z,ne,function(){return[De]}],(function(e){return oe(De(e.data[0],se(e.data[1])))}),5,r)}function De(e,t){return S((ge(e),e.subarray(2,-4)),t)}var Ke=function(){function e(e){this.G=Ue,this.I=je,this.Z=ke,this.ondata=e}return e.prototype.push=function(e,t){if(!this.ondata)throw"no stream handler";if(this.s)this.s.push(e,t);else{if(this.p&&this.p.length){var r=new o(this.p.length+e.length);r.set(this.p),r.set(e,this.p.length)}else this.p=e;if(this.p.length>2){var n=this,s=function(){n.ondata.apply(n,arguments)};this.s=31==this.p[0]&&139==this.p[1]&&8==this.p[2]?new this.G(s):8!=(15&this.p[0])||this.p[0]>>4>7||(this.p[0]<<8|this.p[1])%31?new this.I(s):new this.Z(s),this.s.push(this.p,t),this.p=null}}},e}(),ze=function(){function e(e){this.G=Se,this.I=_e,this.Z=Re,this.ondata=e}return e.prototype.push=function(e,t){Ke.prototype.push.call(this,e,t)},e}();function Ve(e,t,r){if(r||(r=t,t={}),"function"!=typeof r)throw"no callback";return 31==e[0]&&139==e[1]&&8==e[2]?Le(e,t,r):8!=(15&e[0])||e[0]>>4>7||(e[0]<<8|e[1])%31?Ce(e,t,r):Me(e,t,r)}function qe(e,t){return 31==e[0]&&139==e[1]&&8==e[2]?Te(e,t):8!=(15&e[0])||e[0]>>4>7||(e[0]<<8|e[1])%31?xe(e,t):De(e,t)}var Ge=function(e,t,r,n){for(var s in e){var i=e[s],a=t+s;i instanceof o?r[a]=[i,n]:Array.isArray(i)?r[a]=[i[0],X(n,i[1])]:Ge(i,a+"/",r,n)}};function Xe(e,t){var r=e.length;if(!t&&"undefined"!=typeof TextEncoder)return(new TextEncoder).encode(e);for(var n=new o(e.length+(e.length>>>1)),s=0,i=function(e){n[s++]=e},a=0;a<r;++a){if(s+5>n.length){var A=new o(s+8+(r-a<<1));A.set(n),n=A}var u=e.charCodeAt(a);u<128||t?i(u):u<2048?(i(192|u>>>6),i(128|63&u)):u>55295&&u<57344?(i(240|(u=65536+(1047552&u)|1023&e.charCodeAt(++a))>>>18),i(128|u>>>12&63),i(128|u>>>6&63),i(128|63&u)):(i(224|u>>>12),i(128|u>>>6&63),i(128|63&u))}return U(n,0,s)}function We(e,t){var r="";if(!t&&"undefined"!=typeof TextDecoder)return(new TextDecoder).decode(e);for(var n=0;n<e.length;){var o=e[n++];o<128||t?r+=String.fromCharCode(o):o<224?r+=String.fromCharCode((31&o)<<6|63&e[n++]):o<240?r+=String.fromCharCode((15&o)<<12|(63&e[n++])<<6|63&e[n++]):(o=((15&o)<<18|(63&e[n++])<<12|(63&e[n++])<<6|63&e[n++])-65536,r+=String.fromCharCode(55296|o>>10,56320|1023&o))}return r}var Je=function(e,t){return t+30+ue(e,t+26)+ue(e,t+28)},Ye=function(e,t,r){var n=ue(e,t+28),o=We(e.subarray(t+46,t+46+n),!(2048&ue(e,t+8))),s=t+46+n,i=r?Ze(e,s):[ce(e,t+20),ce(e,t+24),ce(e,t+42)],a=i[0],A=i[1],u=i[2];return[ue(e,t+10),a,A,o,s+ue(e,t+30)+ue(e,t+32),u]},Ze=function(e,t){for(;1!=ue(e,t);t+=4+ue(e,t+2));return[ce(e,t+12),ce(e,t+4),ce(e,t+20)]},$e=function(e,t,r,n,o,s,i,a,A,u){var c=s.length,l=n.length;le(e,t,null!=A?33639248:67324752),t+=4,null!=A&&(e[t]=20,t+=2),e[t]=20,t+=2,e[t++]=8==u&&(1==a.level?6:a.level<6?4:9==a.level?2:0),e[t++]=i&&8,e[t]=u,t+=2;var d=new Date(a.mtime||Date.now()),f=d.getFullYear()-1980;if(f<0||f>119)throw"date not in range 1980-2099";le(e,t,2*(f<<24)|d.getMonth()+1<<21|d.getDate()<<16|d.getHours()<<11|d.getMinutes()<<5|d.getSeconds()>>>1),le(e,t+=4,r),le(e,t+4,l),le(e,t+8,o),le(e,t+12,c),t+=16,null!=A&&(le(e,t+=10,A),t+=4),e.set(s,t),t+=c,null==A&&e.set(n,t)},et=function(e,t,r,n,o){le(e,t,101010256),le(e,t+8,r),le(e,t+10,r),le(e,t+12,n),le(e,t+16,o)};function tt(e,t,r){if(r||(r=t,t={}),"function"!=typeof r)throw"no callback";var n={};Ge(e,"",n,t);var s=Object.keys(n),i=s.length,a=0,A=0,u=i,c=new Array(i),l=[],d=function(){for(var e=0;e<l.length;++e)l[e]()},f=function(){var e=new o(A+22),t=a,n=A-a;A=0;for(var s=0;s<u;++s){var i=c[s];try{$e(e,A,i.c,i.d,i.m,i.n,i.u,i.p,null,i.t),$e(e,a,i.c,i.d,i.m,i.n,i.u,i.p,A,i.t),a+=46+i.n.length,A+=30+i.n.length+i.d.length}catch(e){return r(e,null)}}et(e,a,c.length,n,t),r(null,e)};i||f();for(var h=function(e){var t=s[e],o=n[t],u=o[0],h=o[1],p=V(),m=u.length;p.p(u);var g=Xe(t),y=g.length,v=0==h.level?0:8,w=function(n,o){if(n)d(),r(n,null);else{var s=o.length;c[e]={t:v,d:o,m:m,c:p.d(),u:t.length!=s,n:g,p:h},a+=30+y+s,A+=76+2*y+s,--i||f()}};if(g.length>65535&&w("filename too long",null),v)if(m<16e4)try{w(null,Be(u,h))}catch(e){w(e,null)}else l.push(be(u,h,w));else w(null,u)},p=0;p<u;++p)h(p);return d}function rt(e,t){void 0===t&&(t={});var r={},n=[];Ge(e,"",r,t);var s=0,i=0;for(var a in r){var A=r[a],u=A[0],c=A[1],l=0==c.level?0:8,d=Xe(a),f=d.length;if(d.length>65535)throw"filename too long";var h=l?Be(u,c):u,p=h.length,m=V();m.p(u),n.push({t:l,d:h,m:u.length,c:m.d(),u:a.length!=f,n:d,o:s,p:c}),s+=30+f+p,i+=76+2*f+p}for(var g=new o(i+22),y=s,v=i-s,w=0;w<n.length;++w){var b=n[w];$e(g,b.o,b.c,b.d,b.m,b.n,b.u,b.p,null,b.t),$e(g,s,b.c,b.d,b.m,b.n,b.u,b.p,b.o,b.t),s+=46+b.n.length}return et(g,s,n.length,v,y),g}function nt(e,t){if("function"!=typeof t)throw"no callback";for(var r=[],n=function(){for(var e=0;e<r.length;++e)r[e]()},s={},i=e.length-22;101010256!=ce(e,i);--i)if(!i||e.length-i>65558)return void t("invalid zip file",null);var a=ue(e,i+8);a||t(null,{});var A=a,u=ce(e,i+16),c=4294967295==u;if(c){if(i=ce(e,i-12),101075792!=ce(e,i))throw"invalid zip file";A=a=ce(e,i+32),u=ce(e,i+48)}for(var l=function(i){var A=Ye(e,u,c),l=A[0],d=A[1],f=A[2],h=A[3],p=A[4],m=A[5],g=Je(e,m);u=p;var y=function(e,r){e?(n(),t(e,null)):(s[h]=r,--a||t(null,s))};if(l)if(8==l){var v=e.subarray(g,g+d);if(d<32e4)try{y(null,xe(v,new o(f)))}catch(e){y(e,null)}else r.push(Ce(v,{size:f},y))}else y("unknown compression type "+l,null);else y(null,U(e,g,g+d))},d=0;d<A;++d)l();return n}function ot(e){for(var t={},r=e.length-22;101010256!=ce(e,r);--r)if(!r||e.length-r>65558)throw"invalid zip file";var n=ue(e,r+8);if(!n)return{};var s=ce(e,r+16),i=4294967295==s;if(i){if(r=ce(e,r-12),101075792!=ce(e,r))throw"invalid zip file";n=ce(e,r+32),s=ce(e,r+48)}for(var a=0;a<n;++a){var A=Ye(e,s,i),u=A[0],c=A[1],l=A[2],d=A[3],f=A[4],h=A[5],p=Je(e,h);if(s=f,u){if(8!=u)throw"unknown compression type "+u;t[d]=xe(e.subarray(p,p+c),new o(l))}else t[d]=U(e,p,p+c)}return t}},"./node_modules/html2canvas/dist/html2canvas.js":function(e){e.exports=function(){"use strict";var e=function(t,r){return(e=Object.setPrototypeOf||{__proto__:[]}instanceof Array&&function(e,t){e.__proto__=t}||function(e,t){for(var r in t)t.hasOwnProperty(r)&&(e[r]=t[r])})(t,r)};function t(t,r){function n(){this.constructor=t}e(t,r),t.prototype=null===r?Object.create(r):(n.prototype=r.prototype,new n)}var r=function(){return(r=Object.assign||function(e){for(var t,r=1,n=arguments.length;r<n;r++)for(var o in t=arguments[r])Object.prototype.hasOwnProperty.call(t,o)&&(e[o]=t[o]);return e}).apply(this,arguments)};function n(e,t,r,n){return new(r||(r=Promise))((function(o,s){function i(e){try{A(n.next(e))}catch(e){s(e)}}function a(e){try{A(n.throw(e))}catch(e){s(e)}}function A(e){e.done?o(e.value):new r((function(t){t(e.value)})).then(i,a)}A((n=n.apply(e,t||[])).next())}))}function o(e,t){var r,n,o,s,i={label:0,sent:function(){if(1&o[0])throw o[1];return o[1]},trys:[],ops:[]};return s={next:a(0),throw:a(1),return:a(2)},"function"==typeof Symbol&&(s[Symbol.iterator]=function(){return this}),s;function a(s){return function(a){return function(s){if(r)throw new TypeError("Generator is already executing.");for(;i;)try{if(r=1,n&&(o=2&s[0]?n.return:s[0]?n.throw||((o=n.return)&&o.call(n),0):n.next)&&!(o=o.call(n,s[1])).done)return o;switch(n=0,o&&(s=[2&s[0],o.value]),s[0]){case 0:case 1:o=s;break;case 4:return i.label++,{value:s[1],done:!1};case 5:i.label++,n=s[1],s=[0];continue;case 7:s=i.ops.pop(),i.trys.pop();continue;default:if(!((o=(o=i.trys).length>0&&o[o.length-1])||6!==s[0]&&2!==s[0])){i=0;continue}if(3===s[0]&&(!o||s[1]>o[0]&&s[1]<o[3])){i.label=s[1];break}if(6===s[0]&&i.label<o[1]){i.label=o[1],o=s;break}if(o&&i.label<o[2]){i.label=o[2],i.ops.push(s);break}o[2]&&i.ops.pop(),i.trys.pop();continue}s=t.call(e,i)}catch(e){s=[6,e],n=0}finally{r=o=0}if(5&s[0])throw s[1];return{value:s[0]?s[1]:void 0,done:!0}}([s,a])}}}for(var s=function(){function e(e,t,r,n){this.left=e,this.top=t,this.width=r,this.height=n}return e.prototype.add=function(t,r,n,o){return new e(this.left+t,this.top+r,this.width+n,this.height+o)},e.fromClientRect=function(t){return new e(t.left,t.top,t.width,t.height)},e}(),i=function(e){return s.fromClientRect(e.getBoundingClientRect())},a=function(e){for(var t=[],r=0,n=e.length;r<n;){var o=e.charCodeAt(r++);if(o>=55296&&o<=56319&&r<n){var s=e.charCodeAt(r++);56320==(64512&s)?t.push(((1023&o)<<10)+(1023&s)+65536):(t.push(o),r--)}else t.push(o)}return t},A=function(){for(var e=[],t=0;t<arguments.length;t++)e[t]=arguments[t];if(String.fromCodePoint)return String.fromCodePoint.apply(String,e);var r=e.length;if(!r)return"";for(var n=[],o=-1,s="";++o<r;){var i=e[o];i<=65535?n.push(i):(i-=65536,n.push(55296+(i>>10),i%1024+56320)),(o+1===r||n.length>16384)&&(s+=String.fromCharCode.apply(String,n),n.length=0)}return s},u="ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/",c="undefined"==typeof Uint8Array?[]:new Uint8Array(256),l=0;l<u.length;l++)c[u.charCodeAt(l)]=l;var d,f,h,p,m,g,y,v,w,b=function(e,t,r){return e.slice?e.slice(t,r):new Uint16Array(Array.prototype.slice.call(e,t,r))},B=function(){function e(e,t,r,n,o,s){this.initialValue=e,this.errorValue=t,this.highStart=r,this.highValueIndex=n,this.index=o,this.data=s}return e.prototype.get=function(e){var t;if(e>=0){if(e<55296||e>56319&&e<=65535)return t=((t=this.index[e>>5])<<2)+(31&e),this.data[t];if(e<=65535)return t=((t=this.index[2048+(e-55296>>5)])<<2)+(31&e),this.data[t];if(e<this.highStart)return t=2080+(e>>11),t=this.index[t],t+=e>>5&63,t=((t=this.index[t])<<2)+(31&e),this.data[t];if(e<=1114111)return this.data[this.highValueIndex]}return this.errorValue},e}(),j=10,_=13,C=15,x=17,E=18,N=19,Q=20,F=21,U=22,S=24,L=25,T=26,H=27,I=28,P=30,O=32,k=33,R=34,M=35,D=37,K=38,z=39,V=40,q=42,G="×",X="÷",W=(m=function(e){var t,r,n,o,s,i=.75*e.length,a=e.length,A=0;"="===e[e.length-1]&&(i--,"="===e[e.length-2]&&i--);var u="undefined"!=typeof ArrayBuffer&&"undefined"!=typeof Uint8Array&&void 0!==Uint8Array.prototype.slice?new ArrayBuffer(i):new Array(i),l=Array.isArray(u)?u:new Uint8Array(u);for(t=0;t<a;t+=4)r=c[e.charCodeAt(t)],n=c[e.charCodeAt(t+1)],o=c[e.charCodeAt(t+2)],s=c[e.charCodeAt(t+3)],l[A++]=r<<2|n>>4,l[A++]=(15&n)<<4|o>>2,l[A++]=(3&o)<<6|63&s;return u}("KwAAAAAAAAAACA4AIDoAAPAfAAACAAAAAAAIABAAGABAAEgAUABYAF4AZgBeAGYAYABoAHAAeABeAGYAfACEAIAAiACQAJgAoACoAK0AtQC9AMUAXgBmAF4AZgBeAGYAzQDVAF4AZgDRANkA3gDmAOwA9AD8AAQBDAEUARoBIgGAAIgAJwEvATcBPwFFAU0BTAFUAVwBZAFsAXMBewGDATAAiwGTAZsBogGkAawBtAG8AcIBygHSAdoB4AHoAfAB+AH+AQYCDgIWAv4BHgImAi4CNgI+AkUCTQJTAlsCYwJrAnECeQKBAk0CiQKRApkCoQKoArACuALAAsQCzAIwANQC3ALkAjAA7AL0AvwCAQMJAxADGAMwACADJgMuAzYDPgOAAEYDSgNSA1IDUgNaA1oDYANiA2IDgACAAGoDgAByA3YDfgOAAIQDgACKA5IDmgOAAIAAogOqA4AAgACAAIAAgACAAIAAgACAAIAAgACAAIAAgACAAIAAgACAAK8DtwOAAIAAvwPHA88D1wPfAyAD5wPsA/QD/AOAAIAABAQMBBIEgAAWBB4EJgQuBDMEIAM7BEEEXgBJBCADUQRZBGEEaQQwADAAcQQ+AXkEgQSJBJEEgACYBIAAoASoBK8EtwQwAL8ExQSAAIAAgACAAIAAgACgAM0EXgBeAF4AXgBeAF4AXgBeANUEXgDZBOEEXgDpBPEE+QQBBQkFEQUZBSEFKQUxBTUFPQVFBUwFVAVcBV4AYwVeAGsFcwV7BYMFiwWSBV4AmgWgBacFXgBeAF4AXgBeAKsFXgCyBbEFugW7BcIFwgXIBcIFwgXQBdQF3AXkBesF8wX7BQMGCwYTBhsGIwYrBjMGOwZeAD8GRwZNBl4AVAZbBl4AXgBeAF4AXgBeAF4AXgBeAF4AXgBeAGMGXgBqBnEGXgBeAF4AXgBeAF4AXgBeAF4AXgB5BoAG4wSGBo4GkwaAAIADHgR5AF4AXgBeAJsGgABGA4AAowarBrMGswagALsGwwbLBjAA0wbaBtoG3QbaBtoG2gbaBtoG2gblBusG8wb7BgMHCwcTBxsHCwcjBysHMAc1BzUHOgdCB9oGSgdSB1oHYAfaBloHaAfaBlIH2gbaBtoG2gbaBtoG2gbaBjUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHbQdeAF4ANQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQd1B30HNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1B4MH2gaKB68EgACAAIAAgACAAIAAgACAAI8HlwdeAJ8HpweAAIAArwe3B14AXgC/B8UHygcwANAH2AfgB4AA6AfwBz4B+AcACFwBCAgPCBcIogEYAR8IJwiAAC8INwg/CCADRwhPCFcIXwhnCEoDGgSAAIAAgABvCHcIeAh5CHoIewh8CH0Idwh4CHkIegh7CHwIfQh3CHgIeQh6CHsIfAh9CHcIeAh5CHoIewh8CH0Idwh4CHkIegh7CHwIfQh3CHgIeQh6CHsIfAh9CHcIeAh5CHoIewh8CH0Idwh4CHkIegh7CHwIfQh3CHgIeQh6CHsIfAh9CHcIeAh5CHoIewh8CH0Idwh4CHkIegh7CHwIfQh3CHgIeQh6CHsIfAh9CHcIeAh5CHoIewh8CH0Idwh4CHkIegh7CHwIfQh3CHgIeQh6CHsIfAh9CHcIeAh5CHoIewh8CH0Idwh4CHkIegh7CHwIfQh3CHgIeQh6CHsIfAh9CHcIeAh5CHoIewh8CH0Idwh4CHkIegh7CHwIfQh3CHgIeQh6CHsIfAh9CHcIeAh5CHoIewh8CH0Idwh4CHkIegh7CHwIfQh3CHgIeQh6CHsIfAh9CHcIeAh5CHoIewh8CH0Idwh4CHkIegh7CHwIfQh3CHgIeQh6CHsIfAh9CHcIeAh5CHoIewh8CH0Idwh4CHkIegh7CHwIfQh3CHgIeQh6CHsIfAh9CHcIeAh5CHoIewh8CH0Idwh4CHkIegh7CHwIfQh3CHgIeQh6CHsIfAh9CHcIeAh5CHoIewh8CH0Idwh4CHkIegh7CHwIfQh3CHgIeQh6CHsIfAh9CHcIeAh5CHoIewh8CH0Idwh4CHkIegh7CHwIfQh3CHgIeQh6CHsIfAh9CHcIeAh5CHoIewh8CH0Idwh4CHkIegh7CHwIfQh3CHgIeQh6CHsIfAh9CHcIeAh5CHoIewh8CH0Idwh4CHkIegh7CHwIfQh3CHgIeQh6CHsIfAh9CHcIeAh5CHoIewh8CH0Idwh4CHkIegh7CHwIfQh3CHgIeQh6CHsIfAh9CHcIeAh5CHoIewh8CH0Idwh4CHkIegh7CHwIhAiLCI4IMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwAJYIlgiWCJYIlgiWCJYIlgiWCJYIlgiWCJYIlgiWCJYIlgiWCJYIlgiWCJYIlgiWCJYIlgiWCJYIlgiWCJYIlggwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAANQc1BzUHNQc1BzUHNQc1BzUHNQc1B54INQc1B6II2gaqCLIIugiAAIAAvgjGCIAAgACAAIAAgACAAIAAgACAAIAAywiHAYAA0wiAANkI3QjlCO0I9Aj8CIAAgACAAAIJCgkSCRoJIgknCTYHLwk3CZYIlgiWCJYIlgiWCJYIlgiWCJYIlgiWCJYIlgiWCJYIlgiWCJYIlgiWCJYIlgiWCJYIlgiWCJYIlgiWCJYIlgiAAIAAAAFAAXgBeAGAAcABeAHwAQACQAKAArQC9AJ4AXgBeAE0A3gBRAN4A7AD8AMwBGgEAAKcBNwEFAUwBXAF4QkhCmEKnArcCgAHHAsABz4LAAcABwAHAAd+C6ABoAG+C/4LAAcABwAHAAc+DF4MAAcAB54M3gweDV4Nng3eDaABoAGgAaABoAGgAaABoAGgAaABoAGgAaABoAGgAaABoAGgAaABoAEeDqABVg6WDqABoQ6gAaABoAHXDvcONw/3DvcO9w73DvcO9w73DvcO9w73DvcO9w73DvcO9w73DvcO9w73DvcO9w73DvcO9w73DvcO9w73DvcO9w73DncPAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcABwAHAAcAB7cPPwlGCU4JMACAAIAAgABWCV4JYQmAAGkJcAl4CXwJgAkwADAAMAAwAIgJgACLCZMJgACZCZ8JowmrCYAAswkwAF4AXgB8AIAAuwkABMMJyQmAAM4JgADVCTAAMAAwADAAgACAAIAAgACAAIAAgACAAIAAqwYWBNkIMAAwADAAMADdCeAJ6AnuCR4E9gkwAP4JBQoNCjAAMACAABUK0wiAAB0KJAosCjQKgAAwADwKQwqAAEsKvQmdCVMKWwowADAAgACAALcEMACAAGMKgABrCjAAMAAwADAAMAAwADAAMAAwADAAMAAeBDAAMAAwADAAMAAwADAAMAAwADAAMAAwAIkEPQFzCnoKiQSCCooKkAqJBJgKoAqkCokEGAGsCrQKvArBCjAAMADJCtEKFQHZCuEK/gHpCvEKMAAwADAAMACAAIwE+QowAIAAPwEBCzAAMAAwADAAMACAAAkLEQswAIAAPwEZCyELgAAOCCkLMAAxCzkLMAAwADAAMAAwADAAXgBeAEELMAAwADAAMAAwADAAMAAwAEkLTQtVC4AAXAtkC4AAiQkwADAAMAAwADAAMAAwADAAbAtxC3kLgAuFC4sLMAAwAJMLlwufCzAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwAIAAgACAAIAAgACAAIAAgACAAIAAgACAAIAAgACAAIAAgACAAIAAgACAAIAAgACAAIAAgACAAIAApwswADAAMACAAIAAgACvC4AAgACAAIAAgACAALcLMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAgACAAIAAgACAAIAAgACAAIAAgACAAIAAgACAAIAAgACAAIAAvwuAAMcLgACAAIAAgACAAIAAyguAAIAAgACAAIAA0QswADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAgACAAIAAgACAAIAAgACAAIAAgACAAIAAgACAANkLgACAAIAA4AswADAAMAAwADAAMAAwADAAMAAwADAAMAAwAIAAgACAAIAAgACAAIAAgACAAIAAgACAAIAAgACAAIAAgACJCR4E6AswADAAhwHwC4AA+AsADAgMEAwwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMACAAIAAGAwdDCUMMAAwAC0MNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQw1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHPQwwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADUHNQc1BzUHNQc1BzUHNQc2BzAAMAA5DDUHNQc1BzUHNQc1BzUHNQc1BzUHNQdFDDAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAgACAAIAATQxSDFoMMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwAF4AXgBeAF4AXgBeAF4AYgxeAGoMXgBxDHkMfwxeAIUMXgBeAI0MMAAwADAAMAAwAF4AXgCVDJ0MMAAwADAAMABeAF4ApQxeAKsMswy7DF4Awgy9DMoMXgBeAF4AXgBeAF4AXgBeAF4AXgDRDNkMeQBqCeAM3Ax8AOYM7Az0DPgMXgBeAF4AXgBeAF4AXgBeAF4AXgBeAF4AXgBeAF4AXgCgAAANoAAHDQ4NFg0wADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAeDSYNMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwAIAAgACAAIAAgACAAC4NMABeAF4ANg0wADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwAD4NRg1ODVYNXg1mDTAAbQ0wADAAMAAwADAAMAAwADAA2gbaBtoG2gbaBtoG2gbaBnUNeg3CBYANwgWFDdoGjA3aBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gaUDZwNpA2oDdoG2gawDbcNvw3HDdoG2gbPDdYN3A3fDeYN2gbsDfMN2gbaBvoN/g3aBgYODg7aBl4AXgBeABYOXgBeACUG2gYeDl4AJA5eACwO2w3aBtoGMQ45DtoG2gbaBtoGQQ7aBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gZJDjUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1B1EO2gY1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQdZDjUHNQc1BzUHNQc1B2EONQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHaA41BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1B3AO2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gY1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1BzUHNQc1B2EO2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gZJDtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBtoG2gbaBkkOeA6gAKAAoAAwADAAMAAwAKAAoACgAKAAoACgAKAAgA4wADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAAwADAAMAD//wQABAAEAAQABAAEAAQABAAEAA0AAwABAAEAAgAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAKABMAFwAeABsAGgAeABcAFgASAB4AGwAYAA8AGAAcAEsASwBLAEsASwBLAEsASwBLAEsAGAAYAB4AHgAeABMAHgBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAFgAbABIAHgAeAB4AUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQABYADQARAB4ABAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsABAAEAAQABAAEAAUABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAkAFgAaABsAGwAbAB4AHQAdAB4ATwAXAB4ADQAeAB4AGgAbAE8ATwAOAFAAHQAdAB0ATwBPABcATwBPAE8AFgBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAHQAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB0AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgBQAB4AHgAeAB4AUABQAFAAUAAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAeAB4AHgAeAFAATwBAAE8ATwBPAEAATwBQAFAATwBQAB4AHgAeAB4AHgAeAB0AHQAdAB0AHgAdAB4ADgBQAFAAUABQAFAAHgAeAB4AHgAeAB4AHgBQAB4AUAAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4ABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAJAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAkACQAJAAkACQAJAAkABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAeAB4AHgAeAFAAHgAeAB4AKwArAFAAUABQAFAAGABQACsAKwArACsAHgAeAFAAHgBQAFAAUAArAFAAKwAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AKwAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4ABAAEAAQABAAEAAQABAAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArACsAUAAeAB4AHgAeAB4AHgArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwAYAA0AKwArAB4AHgAbACsABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQADQAEAB4ABAAEAB4ABAAEABMABAArACsAKwArACsAKwArACsAVgBWAFYAVgBWAFYAVgBWAFYAVgBWAFYAVgBWAFYAVgBWAFYAVgBWAFYAVgBWAFYAVgBWAFYAKwArACsAKwArAFYAVgBWAB4AHgArACsAKwArACsAKwArACsAKwArACsAHgAeAB4AHgAeAB4AHgAeAB4AGgAaABoAGAAYAB4AHgAEAAQABAAEAAQABAAEAAQABAAEAAQAEwAEACsAEwATAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABABLAEsASwBLAEsASwBLAEsASwBLABoAGQAZAB4AUABQAAQAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQABMAUAAEAAQABAAEAAQABAAEAB4AHgAEAAQABAAEAAQABABQAFAABAAEAB4ABAAEAAQABABQAFAASwBLAEsASwBLAEsASwBLAEsASwBQAFAAUAAeAB4AUAAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AKwAeAFAABABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAABAAEAAQABAAEAAQABAAEAAQABAAEAFAAKwArACsAKwArACsAKwArACsAKwArACsAKwArAEsASwBLAEsASwBLAEsASwBLAEsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAABAAEAAQABAAEAAQABAAEAAQAUABQAB4AHgAYABMAUAArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAEAAQABAAEAFAABAAEAAQABAAEAFAABAAEAAQAUAAEAAQABAAEAAQAKwArAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAEAAQABAArACsAHgArAFAAUABQAFAAUABQAFAAUABQAFAAUAArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArAFAAUABQAFAAUABQAFAAUAArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAeAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAEAAQABABQAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAFAABAAEAAQABAAEAAQABABQAFAAUABQAFAAUABQAFAAUABQAAQABAANAA0ASwBLAEsASwBLAEsASwBLAEsASwAeAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAABAAEAAQAKwBQAFAAUABQAFAAUABQAFAAKwArAFAAUAArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAUABQAFAAUABQAFAAUAArAFAAKwArACsAUABQAFAAUAArACsABABQAAQABAAEAAQABAAEAAQAKwArAAQABAArACsABAAEAAQAUAArACsAKwArACsAKwArACsABAArACsAKwArAFAAUAArAFAAUABQAAQABAArACsASwBLAEsASwBLAEsASwBLAEsASwBQAFAAGgAaAFAAUABQAFAAUABMAB4AGwBQAB4AKwArACsABAAEAAQAKwBQAFAAUABQAFAAUAArACsAKwArAFAAUAArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAUABQAFAAUABQAFAAUAArAFAAUAArAFAAUAArAFAAUAArACsABAArAAQABAAEAAQABAArACsAKwArAAQABAArACsABAAEAAQAKwArACsABAArACsAKwArACsAKwArAFAAUABQAFAAKwBQACsAKwArACsAKwArACsASwBLAEsASwBLAEsASwBLAEsASwAEAAQAUABQAFAABAArACsAKwArACsAKwArACsAKwArACsABAAEAAQAKwBQAFAAUABQAFAAUABQAFAAUAArAFAAUABQACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAUABQAFAAUABQAFAAUAArAFAAUAArAFAAUABQAFAAUAArACsABABQAAQABAAEAAQABAAEAAQABAArAAQABAAEACsABAAEAAQAKwArAFAAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAUABQAAQABAArACsASwBLAEsASwBLAEsASwBLAEsASwAeABsAKwArACsAKwArACsAKwBQAAQABAAEAAQABAAEACsABAAEAAQAKwBQAFAAUABQAFAAUABQAFAAKwArAFAAUAArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAEAAQABAAEAAQAKwArAAQABAArACsABAAEAAQAKwArACsAKwArACsAKwArAAQABAArACsAKwArAFAAUAArAFAAUABQAAQABAArACsASwBLAEsASwBLAEsASwBLAEsASwAeAFAAUABQAFAAUABQAFAAKwArACsAKwArACsAKwArACsAKwAEAFAAKwBQAFAAUABQAFAAUAArACsAKwBQAFAAUAArAFAAUABQAFAAKwArACsAUABQACsAUAArAFAAUAArACsAKwBQAFAAKwArACsAUABQAFAAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArACsAKwAEAAQABAAEAAQAKwArACsABAAEAAQAKwAEAAQABAAEACsAKwBQACsAKwArACsAKwArAAQAKwArACsAKwArACsAKwArACsAKwBLAEsASwBLAEsASwBLAEsASwBLAFAAUABQAB4AHgAeAB4AHgAeABsAHgArACsAKwArACsABAAEAAQABAArAFAAUABQAFAAUABQAFAAUAArAFAAUABQACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAKwArAFAABAAEAAQABAAEAAQABAArAAQABAAEACsABAAEAAQABAArACsAKwArACsAKwArAAQABAArAFAAUABQACsAKwArACsAKwBQAFAABAAEACsAKwBLAEsASwBLAEsASwBLAEsASwBLACsAKwArACsAKwArACsAKwBQAFAAUABQAFAAUABQAB4AUAAEAAQABAArAFAAUABQAFAAUABQAFAAUAArAFAAUABQACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwBQAFAAUABQAFAAUABQAFAAUABQACsAUABQAFAAUABQACsAKwAEAFAABAAEAAQABAAEAAQABAArAAQABAAEACsABAAEAAQABAArACsAKwArACsAKwArAAQABAArACsAKwArACsAKwArAFAAKwBQAFAABAAEACsAKwBLAEsASwBLAEsASwBLAEsASwBLACsAUABQACsAKwArACsAKwArACsAKwArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAABAAEAFAABAAEAAQABAAEAAQABAArAAQABAAEACsABAAEAAQABABQAB4AKwArACsAKwBQAFAAUAAEAFAAUABQAFAAUABQAFAAUABQAFAABAAEACsAKwBLAEsASwBLAEsASwBLAEsASwBLAFAAUABQAFAAUABQAFAAUABQABoAUABQAFAAUABQAFAAKwArAAQABAArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArAFAAUABQAFAAUABQAFAAUABQACsAUAArACsAUABQAFAAUABQAFAAUAArACsAKwAEACsAKwArACsABAAEAAQABAAEAAQAKwAEACsABAAEAAQABAAEAAQABAAEACsAKwArACsAKwArAEsASwBLAEsASwBLAEsASwBLAEsAKwArAAQABAAeACsAKwArACsAKwArACsAKwArACsAKwArAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXAAqAFwAXAAqACoAKgAqACoAKgAqACsAKwArACsAGwBcAFwAXABcAFwAXABcACoAKgAqACoAKgAqACoAKgAeAEsASwBLAEsASwBLAEsASwBLAEsADQANACsAKwArACsAKwBcAFwAKwBcACsAKwBcAFwAKwBcACsAKwBcACsAKwArACsAKwArAFwAXABcAFwAKwBcAFwAXABcAFwAXABcACsAXABcAFwAKwBcACsAXAArACsAXABcACsAXABcAFwAXAAqAFwAXAAqACoAKgAqACoAKgArACoAKgBcACsAKwBcAFwAXABcAFwAKwBcACsAKgAqACoAKgAqACoAKwArAEsASwBLAEsASwBLAEsASwBLAEsAKwArAFwAXABcAFwAUAAOAA4ADgAOAB4ADgAOAAkADgAOAA0ACQATABMAEwATABMACQAeABMAHgAeAB4ABAAEAB4AHgAeAB4AHgAeAEsASwBLAEsASwBLAEsASwBLAEsAUABQAFAAUABQAFAAUABQAFAAUAANAAQAHgAEAB4ABAAWABEAFgARAAQABABQAFAAUABQAFAAUABQAFAAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArACsAKwArAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAANAAQABAAEAAQABAANAAQABABQAFAAUABQAFAABAAEAAQABAAEAAQABAAEAAQABAAEACsABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEACsADQANAB4AHgAeAB4AHgAeAAQAHgAeAB4AHgAeAB4AKwAeAB4ADgAOAA0ADgAeAB4AHgAeAB4ACQAJACsAKwArACsAKwBcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAKgAqACoAKgAqACoAKgAqACoAKgAqACoAKgAqACoAKgAqACoAKgAqAFwASwBLAEsASwBLAEsASwBLAEsASwANAA0AHgAeAB4AHgBcAFwAXABcAFwAXAAqACoAKgAqAFwAXABcAFwAKgAqACoAXAAqACoAKgBcAFwAKgAqACoAKgAqACoAKgBcAFwAXAAqACoAKgAqAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAKgAqACoAKgAqACoAKgAqACoAKgAqACoAXAAqAEsASwBLAEsASwBLAEsASwBLAEsAKgAqACoAKgAqACoAUABQAFAAUABQAFAAKwBQACsAKwArACsAKwBQACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAeAFAAUABQAFAAWABYAFgAWABYAFgAWABYAFgAWABYAFgAWABYAFgAWABYAFgAWABYAFgAWABYAFgAWABYAFgAWABYAFgAWABYAFkAWQBZAFkAWQBZAFkAWQBZAFkAWQBZAFkAWQBZAFkAWQBZAFkAWQBZAFkAWQBZAFkAWQBZAFkAWQBZAFkAWQBaAFoAWgBaAFoAWgBaAFoAWgBaAFoAWgBaAFoAWgBaAFoAWgBaAFoAWgBaAFoAWgBaAFoAWgBaAFoAWgBaAFoAUABQAFAAUABQAFAAUABQAFAAKwBQAFAAUABQACsAKwBQAFAAUABQAFAAUABQACsAUAArAFAAUABQAFAAKwArAFAAUABQAFAAUABQAFAAUABQACsAUABQAFAAUAArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAUABQAFAAUAArACsAUABQAFAAUABQAFAAUAArAFAAKwBQAFAAUABQACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArAFAAUABQAFAAKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAKwAEAAQABAAeAA0AHgAeAB4AHgAeAB4AHgBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAeAB4AHgAeAB4AHgAeAB4AHgAeACsAKwArACsAKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArAFAAUABQAFAAUABQACsAKwANAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAeAB4AUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAA0AUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQABYAEQArACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAADQANAA0AUABQAFAAUABQAFAAUABQAFAAUABQACsAKwArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArAFAAUABQAFAABAAEAAQAKwArACsAKwArACsAKwArACsAKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAAQABAAEAA0ADQArACsAKwArACsAKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAEAAQAKwArACsAKwArACsAKwArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArAFAAUABQACsABAAEACsAKwArACsAKwArACsAKwArACsAKwArAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXAAqACoAKgAqACoAKgAqACoAKgAqACoAKgAqACoAKgAqACoAKgAqACoADQANABUAXAANAB4ADQAbAFwAKgArACsASwBLAEsASwBLAEsASwBLAEsASwArACsAKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQACsAKwArACsAKwArAB4AHgATABMADQANAA4AHgATABMAHgAEAAQABAAJACsASwBLAEsASwBLAEsASwBLAEsASwArACsAKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArACsAKwArACsAKwArACsAUABQAFAAUABQAAQABABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAABABQACsAKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAKwArACsAKwArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArAAQABAAEAAQABAAEAAQABAAEAAQABAAEACsAKwArACsABAAEAAQABAAEAAQABAAEAAQABAAEAAQAKwArACsAKwAeACsAKwArABMAEwBLAEsASwBLAEsASwBLAEsASwBLAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcACsAKwBcAFwAXABcAFwAKwArACsAKwArACsAKwArACsAKwArAFwAXABcAFwAXABcAFwAXABcAFwAXABcACsAKwArACsAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAKwArACsAKwArACsASwBLAEsASwBLAEsASwBLAEsASwBcACsAKwArACoAKgBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAABAAEAAQABAAEACsAKwAeAB4AXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAKgAqACoAKgAqACoAKgAqACoAKgArACoAKgAqACoAKgAqACoAKgAqACoAKgAqACoAKgAqACoAKgAqACoAKgAqACoAKgAqACoAKgAqACoAKgArACsABABLAEsASwBLAEsASwBLAEsASwBLACsAKwArACsAKwArAEsASwBLAEsASwBLAEsASwBLAEsAKwArACsAKwArACsAKgAqACoAKgAqACoAKgBcACoAKgAqACoAKgAqACsAKwAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAArAAQABAAEAAQABABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAEAAQABAAEAAQAUABQAFAAUABQAFAAUAArACsAKwArAEsASwBLAEsASwBLAEsASwBLAEsADQANAB4ADQANAA0ADQAeAB4AHgAeAB4AHgAeAB4AHgAeAAQABAAEAAQABAAEAAQABAAEAB4AHgAeAB4AHgAeAB4AHgAeACsAKwArAAQABAAEAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQAUABQAEsASwBLAEsASwBLAEsASwBLAEsAUABQAFAAUABQAFAAUABQAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAArACsAKwArACsAKwArACsAHgAeAB4AHgBQAFAAUABQAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAArACsAKwANAA0ADQANAA0ASwBLAEsASwBLAEsASwBLAEsASwArACsAKwBQAFAAUABLAEsASwBLAEsASwBLAEsASwBLAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAANAA0AUABQAFAAUABQAFAAUABQAFAAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArAB4AHgAeAB4AHgAeAB4AHgArACsAKwArACsAKwArACsABAAEAAQAHgAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAFAAUABQAFAABABQAFAAUABQAAQABAAEAFAAUAAEAAQABAArACsAKwArACsAKwAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQAKwAEAAQABAAEAAQAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgArACsAUABQAFAAUABQAFAAKwArAFAAUABQAFAAUABQAFAAUAArAFAAKwBQACsAUAArAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AKwArAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeACsAHgAeAB4AHgAeAB4AHgAeAFAAHgAeAB4AUABQAFAAKwAeAB4AHgAeAB4AHgAeAB4AHgAeAFAAUABQAFAAKwArAB4AHgAeAB4AHgAeACsAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgArACsAUABQAFAAKwAeAB4AHgAeAB4AHgAeAA4AHgArAA0ADQANAA0ADQANAA0ACQANAA0ADQAIAAQACwAEAAQADQAJAA0ADQAMAB0AHQAeABcAFwAWABcAFwAXABYAFwAdAB0AHgAeABQAFAAUAA0AAQABAAQABAAEAAQABAAJABoAGgAaABoAGgAaABoAGgAeABcAFwAdABUAFQAeAB4AHgAeAB4AHgAYABYAEQAVABUAFQAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgANAB4ADQANAA0ADQAeAA0ADQANAAcAHgAeAB4AHgArAAQABAAEAAQABAAEAAQABAAEAAQAUABQACsAKwBPAFAAUABQAFAAUAAeAB4AHgAWABEATwBQAE8ATwBPAE8AUABQAFAAUABQAB4AHgAeABYAEQArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArACsAGwAbABsAGwAbABsAGwAaABsAGwAbABsAGwAbABsAGwAbABsAGwAbABsAGwAaABsAGwAbABsAGgAbABsAGgAbABsAGwAbABsAGwAbABsAGwAbABsAGwAbABsAGwAbABsABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArAB4AHgBQABoAHgAdAB4AUAAeABoAHgAeAB4AHgAeAB4AHgAeAB4ATwAeAFAAGwAeAB4AUABQAFAAUABQAB4AHgAeAB0AHQAeAFAAHgBQAB4AUAAeAFAATwBQAFAAHgAeAB4AHgAeAB4AHgBQAFAAUABQAFAAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgBQAB4AUABQAFAAUABPAE8AUABQAFAAUABQAE8AUABQAE8AUABPAE8ATwBPAE8ATwBPAE8ATwBPAE8ATwBQAFAAUABQAE8ATwBPAE8ATwBPAE8ATwBPAE8AUABQAFAAUABQAFAAUABQAFAAHgAeAFAAUABQAFAATwAeAB4AKwArACsAKwAdAB0AHQAdAB0AHQAdAB0AHQAdAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAdAB4AHQAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHQAeAB0AHQAeAB4AHgAdAB0AHgAeAB0AHgAeAB4AHQAeAB0AGwAbAB4AHQAeAB4AHgAeAB0AHgAeAB0AHQAdAB0AHgAeAB0AHgAdAB4AHQAdAB0AHQAdAB0AHgAdAB4AHgAeAB4AHgAdAB0AHQAdAB4AHgAeAB4AHQAdAB4AHgAeAB4AHgAeAB4AHgAeAB4AHQAeAB4AHgAdAB4AHgAeAB4AHgAdAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHQAdAB4AHgAdAB0AHQAdAB4AHgAdAB0AHgAeAB0AHQAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAdAB0AHgAeAB0AHQAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB0AHgAeAB4AHQAeAB4AHgAeAB4AHgAeAB0AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAdAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeABQAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAWABEAFgARAB4AHgAeAB4AHgAeAB0AHgAeAB4AHgAeAB4AHgAlACUAHgAeAB4AHgAeAB4AHgAeAB4AFgARAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeACUAJQAlACUAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwBPAE8ATwBPAE8ATwBPAE8ATwBPAE8ATwBPAE8ATwBPAE8ATwBPAE8ATwBPAE8ATwBPAE8ATwBPAE8ATwBPAE8AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQBPAE8ATwBPAE8ATwBPAE8ATwBPAE8ATwBPAE8ATwBPAE8ATwBPAE8ATwBQAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB4AHgAeAB4AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHgAeAB0AHQAdAB0AHgAeAB4AHgAeAB4AHgAeAB4AHgAdAB0AHgAdAB0AHQAdAB0AHQAdAB4AHgAeAB4AHgAeAB4AHgAdAB0AHgAeAB0AHQAeAB4AHgAeAB0AHQAeAB4AHgAeAB0AHQAdAB4AHgAdAB4AHgAdAB0AHQAdAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHQAdAB0AHQAeAB4AHgAeAB4AHgAeAB4AHgAdAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AJQAlACUAJQAeAB0AHQAeAB4AHQAeAB4AHgAeAB0AHQAeAB4AHgAeACUAJQAdAB0AJQAeACUAJQAlACAAJQAlAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AJQAlACUAHgAeAB4AHgAdAB4AHQAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHQAdAB4AHQAdAB0AHgAdACUAHQAdAB4AHQAdAB4AHQAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAlAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB0AHQAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AJQAlACUAJQAlACUAJQAlACUAJQAlACUAHQAdAB0AHQAlAB4AJQAlACUAHQAlACUAHQAdAB0AJQAlAB0AHQAlAB0AHQAlACUAJQAeAB0AHgAeAB4AHgAdAB0AJQAdAB0AHQAdAB0AHQAlACUAJQAlACUAHQAlACUAIAAlAB0AHQAlACUAJQAlACUAJQAlACUAHgAeAB4AJQAlACAAIAAgACAAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAdAB4AHgAeABcAFwAXABcAFwAXAB4AEwATACUAHgAeAB4AFgARABYAEQAWABEAFgARABYAEQAWABEAFgARAE8ATwBPAE8ATwBPAE8ATwBPAE8ATwBPAE8ATwBPAE8ATwBPAE8ATwBPAE8AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAWABEAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AFgARABYAEQAWABEAFgARABYAEQAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeABYAEQAWABEAFgARABYAEQAWABEAFgARABYAEQAWABEAFgARABYAEQAWABEAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AFgARABYAEQAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeABYAEQAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHQAdAB0AHQAdAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AKwArAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AKwArACsAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AKwAeAB4AHgAeAB4AHgAeAB4AHgArACsAKwArACsAKwArACsAKwArACsAKwArAB4AHgAeAB4AKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAEAAQABAAeAB4AKwArACsAKwArABMADQANAA0AUAATAA0AUABQAFAAUABQAFAAUABQACsAKwArACsAKwArACsAUAANACsAKwArACsAKwArACsAKwArACsAKwArACsAKwAEAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArACsAKwArACsAKwArACsAKwBQAFAAUABQAFAAUABQACsAUABQAFAAUABQAFAAUAArAFAAUABQAFAAUABQAFAAKwBQAFAAUABQAFAAUABQACsAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXAA0ADQANAA0ADQANAA0ADQAeAA0AFgANAB4AHgAXABcAHgAeABcAFwAWABEAFgARABYAEQAWABEADQANAA0ADQATAFAADQANAB4ADQANAB4AHgAeAB4AHgAMAAwADQANAA0AHgANAA0AFgANAA0ADQANAA0ADQANACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACsAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAKwArACsAKwArACsAKwArACsAKwArACsAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwAlACUAJQAlACUAJQAlACUAJQAlACUAJQArACsAKwArAA0AEQARACUAJQBHAFcAVwAWABEAFgARABYAEQAWABEAFgARACUAJQAWABEAFgARABYAEQAWABEAFQAWABEAEQAlAFcAVwBXAFcAVwBXAFcAVwBXAAQABAAEAAQABAAEACUAVwBXAFcAVwA2ACUAJQBXAFcAVwBHAEcAJQAlACUAKwBRAFcAUQBXAFEAVwBRAFcAUQBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFEAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBRAFcAUQBXAFEAVwBXAFcAVwBXAFcAUQBXAFcAVwBXAFcAVwBRAFEAKwArAAQABAAVABUARwBHAFcAFQBRAFcAUQBXAFEAVwBRAFcAUQBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFEAVwBRAFcAUQBXAFcAVwBXAFcAVwBRAFcAVwBXAFcAVwBXAFEAUQBXAFcAVwBXABUAUQBHAEcAVwArACsAKwArACsAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAKwArAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwArACUAJQBXAFcAVwBXACUAJQAlACUAJQAlACUAJQAlACUAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAKwArACsAKwArACUAJQAlACUAKwArACsAKwArACsAKwArACsAKwArACsAUQBRAFEAUQBRAFEAUQBRAFEAUQBRAFEAUQBRAFEAUQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACsAVwBXAFcAVwBXAFcAVwBXAFcAVwAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlAE8ATwBPAE8ATwBPAE8ATwAlAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXACUAJQAlACUAJQAlACUAJQAlACUAVwBXAFcAVwBXAFcAVwBXAFcAVwBXACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAEcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAKwArACsAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQArACsAKwArACsAKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAADQATAA0AUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABLAEsASwBLAEsASwBLAEsASwBLAFAAUAArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAFAABAAEAAQABAAeAAQABAAEAAQABAAEAAQABAAEAAQAHgBQAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AUABQAAQABABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAAQABAAeAA0ADQANAA0ADQArACsAKwArACsAKwArACsAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAFAAUABQAFAAUABQAFAAUABQAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AUAAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgBQAB4AHgAeAB4AHgAeAFAAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgArAB4AHgAeAB4AHgAeAB4AHgArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAAQAUABQAFAABABQAFAAUABQAAQAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAAQABAAEAAQABAAeAB4AHgAeACsAKwArACsAUABQAFAAUABQAFAAHgAeABoAHgArACsAKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAADgAOABMAEwArACsAKwArACsAKwArACsABAAEAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAAQABAAEAAQABAAEACsAKwArACsAKwArACsAKwANAA0ASwBLAEsASwBLAEsASwBLAEsASwArACsAKwArACsAKwAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABABQAFAAUABQAFAAUAAeAB4AHgBQAA4AUAArACsAUABQAFAAUABQAFAABAAEAAQABAAEAAQABAAEAA0ADQBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQAKwArACsAKwArACsAKwArACsAKwArAB4AWABYAFgAWABYAFgAWABYAFgAWABYAFgAWABYAFgAWABYAFgAWABYAFgAWABYAFgAWABYAFgAWABYACsAKwArAAQAHgAeAB4AHgAeAB4ADQANAA0AHgAeAB4AHgArAFAASwBLAEsASwBLAEsASwBLAEsASwArACsAKwArAB4AHgBcAFwAXABcAFwAKgBcAFwAXABcAFwAXABcAFwAXABcAEsASwBLAEsASwBLAEsASwBLAEsAXABcAFwAXABcACsAUABQAFAAUABQAFAAUABQAFAABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEACsAKwArACsAKwArACsAKwArAFAAUABQAAQAUABQAFAAUABQAFAAUABQAAQABAArACsASwBLAEsASwBLAEsASwBLAEsASwArACsAHgANAA0ADQBcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAKgAqACoAXAAqACoAKgBcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXAAqAFwAKgAqACoAXABcACoAKgBcAFwAXABcAFwAKgAqAFwAKgBcACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArAFwAXABcACoAKgBQAFAAUABQAFAAUABQAFAAUABQAFAABAAEAAQABAAEAA0ADQBQAFAAUAAEAAQAKwArACsAKwArACsAKwArACsAKwBQAFAAUABQAFAAUAArACsAUABQAFAAUABQAFAAKwArAFAAUABQAFAAUABQACsAKwArACsAKwArACsAKwArAFAAUABQAFAAUABQAFAAKwBQAFAAUABQAFAAUABQACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAEAAQABAAEAAQABAAEAAQADQAEAAQAKwArAEsASwBLAEsASwBLAEsASwBLAEsAKwArACsAKwArACsAVABVAFUAVQBVAFUAVQBVAFUAVQBVAFUAVQBVAFUAVQBVAFUAVQBVAFUAVQBVAFUAVQBVAFUAVQBUAFUAVQBVAFUAVQBVAFUAVQBVAFUAVQBVAFUAVQBVAFUAVQBVAFUAVQBVAFUAVQBVAFUAVQBVACsAKwArACsAKwArACsAKwArACsAKwArAFkAWQBZAFkAWQBZAFkAWQBZAFkAWQBZAFkAWQBZAFkAWQBZAFkAKwArACsAKwBaAFoAWgBaAFoAWgBaAFoAWgBaAFoAWgBaAFoAWgBaAFoAWgBaAFoAWgBaAFoAWgBaAFoAWgBaAFoAKwArACsAKwAGAAYABgAGAAYABgAGAAYABgAGAAYABgAGAAYABgAGAAYABgAGAAYABgAGAAYABgAGAAYABgAGAAYABgAGAAYAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXACUAJQBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAJQAlACUAJQAlACUAUABQAFAAUABQAFAAUAArACsAKwArACsAKwArACsAKwArACsAKwBQAFAAUABQAFAAKwArACsAKwArAFYABABWAFYAVgBWAFYAVgBWAFYAVgBWAB4AVgBWAFYAVgBWAFYAVgBWAFYAVgBWAFYAVgArAFYAVgBWAFYAVgArAFYAKwBWAFYAKwBWAFYAKwBWAFYAVgBWAFYAVgBWAFYAVgBWAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAEQAWAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUAAaAB4AKwArAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQAGAARABEAGAAYABMAEwAWABEAFAArACsAKwArACsAKwAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEACUAJQAlACUAJQAWABEAFgARABYAEQAWABEAFgARABYAEQAlACUAFgARACUAJQAlACUAJQAlACUAEQAlABEAKwAVABUAEwATACUAFgARABYAEQAWABEAJQAlACUAJQAlACUAJQAlACsAJQAbABoAJQArACsAKwArAFAAUABQAFAAUAArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArAAcAKwATACUAJQAbABoAJQAlABYAEQAlACUAEQAlABEAJQBXAFcAVwBXAFcAVwBXAFcAVwBXABUAFQAlACUAJQATACUAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXABYAJQARACUAJQAlAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwAWACUAEQAlABYAEQARABYAEQARABUAVwBRAFEAUQBRAFEAUQBRAFEAUQBRAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAEcARwArACsAVwBXAFcAVwBXAFcAKwArAFcAVwBXAFcAVwBXACsAKwBXAFcAVwBXAFcAVwArACsAVwBXAFcAKwArACsAGgAbACUAJQAlABsAGwArAB4AHgAeAB4AHgAeAB4AKwArACsAKwArACsAKwArACsAKwAEAAQABAAQAB0AKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwBQAFAAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArACsAKwArACsADQANAA0AKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAKwArAB4AHgAeAB4AHgAeAB4AHgAeAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgBQAFAAHgAeAB4AKwAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgArACsAKwArAB4AKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4ABAArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArAAQAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArACsAKwArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAEAAQABAAEAAQAKwArACsAKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsADQBQAFAAUABQACsAKwArACsAUABQAFAAUABQAFAAUABQAA0AUABQAFAAUABQACsAKwArACsAKwArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArACsAKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArACsAKwArACsAKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArACsAKwArACsAKwArACsAKwArAB4AKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwBQAFAAUABQAFAAUAArACsAUAArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAUABQACsAKwArAFAAKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArAA0AUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAB4AHgBQAFAAUABQAFAAUABQACsAKwArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAUABQACsAKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArACsADQBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArACsAKwArAB4AUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArACsAKwBQAFAAUABQAFAABAAEAAQAKwAEAAQAKwArACsAKwArAAQABAAEAAQAUABQAFAAUAArAFAAUABQACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAKwArACsABAAEAAQAKwArACsAKwAEAFAAUABQAFAAUABQAFAAUAArACsAKwArACsAKwArACsADQANAA0ADQANAA0ADQANAB4AKwArACsAKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAB4AUABQAFAAUABQAFAAUABQAB4AUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAABAAEACsAKwArACsAUABQAFAAUABQAA0ADQANAA0ADQANABQAKwArACsAKwArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArACsAKwANAA0ADQANAA0ADQANAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAKwArACsAKwArACsAHgAeAB4AHgArACsAKwArACsAKwArACsAKwArACsAKwBQAFAAUABQAFAAUABQACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArACsAKwArACsAKwArACsAKwArACsAKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArACsAKwArACsAKwBQAFAAUABQAFAAUAAEAAQABAAEAAQABAAEAA0ADQAeAB4AHgAeAB4AKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAEsASwBLAEsASwBLAEsASwBLAEsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsABABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAAQABAAEAAQABAAEAAQABAAEAAQABAAeAB4AHgANAA0ADQANACsAKwArACsAKwArACsAKwArACsAKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArACsAKwArACsAKwBLAEsASwBLAEsASwBLAEsASwBLACsAKwArACsAKwArAFAAUABQAFAAUABQAFAABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEACsASwBLAEsASwBLAEsASwBLAEsASwANAA0ADQANACsAKwArACsAKwArACsAKwArACsAKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAABAAeAA4AUAArACsAKwArACsAKwArACsAKwAEAFAAUABQAFAADQANAB4ADQAeAAQABAAEAB4AKwArAEsASwBLAEsASwBLAEsASwBLAEsAUAAOAFAADQANAA0AKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArACsAKwArACsAKwArACsAKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAEAAQABAAEAAQABAAEAAQABAAEAAQABAANAA0AHgANAA0AHgAEACsAUABQAFAAUABQAFAAUAArAFAAKwBQAFAAUABQACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwBQAFAAUABQAFAAUABQAFAAUABQAA0AKwArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAEAAQABAAEAAQABAAEAAQABAAEAAQAKwArACsAKwArAEsASwBLAEsASwBLAEsASwBLAEsAKwArACsAKwArACsABAAEAAQABAArAFAAUABQAFAAUABQAFAAUAArACsAUABQACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAAQABAAEAAQABAArACsABAAEACsAKwAEAAQABAArACsAUAArACsAKwArACsAKwAEACsAKwArACsAKwBQAFAAUABQAFAABAAEACsAKwAEAAQABAAEAAQABAAEACsAKwArAAQABAAEAAQABAArACsAKwArACsAKwArACsAKwArACsABAAEAAQABAAEAAQABABQAFAAUABQAA0ADQANAA0AHgBLAEsASwBLAEsASwBLAEsASwBLACsADQArAB4AKwArAAQABAAEAAQAUABQAB4AUAArACsAKwArACsAKwArACsASwBLAEsASwBLAEsASwBLAEsASwArACsAKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAEAAQABAAEAAQABAAEACsAKwAEAAQABAAEAAQABAAEAAQABAAOAA0ADQATABMAHgAeAB4ADQANAA0ADQANAA0ADQANAA0ADQANAA0ADQANAA0AUABQAFAAUAAEAAQAKwArAAQADQANAB4AUAArACsAKwArACsAKwArACsAKwArACsASwBLAEsASwBLAEsASwBLAEsASwArACsAKwArACsAKwAOAA4ADgAOAA4ADgAOAA4ADgAOAA4ADgAOACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsASwBLAEsASwBLAEsASwBLAEsASwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXABcAFwAXAArACsAKwAqACoAKgAqACoAKgAqACoAKgAqACoAKgAqACoAKgArACsAKwArAEsASwBLAEsASwBLAEsASwBLAEsAXABcAA0ADQANACoASwBLAEsASwBLAEsASwBLAEsASwBQAFAAUABQAFAAUABQAFAAUAArACsAKwArACsAKwArACsAKwArACsAKwBQAFAABAAEAAQABAAEAAQABAAEAAQABABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAEAAQABAAEAAQABAAEAFAABAAEAAQABAAOAB4ADQANAA0ADQAOAB4ABAArACsAKwArACsAKwArACsAUAAEAAQABAAEAAQABAAEAAQABAAEAAQAUABQAFAAUAArACsAUABQAFAAUAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAA0ADQANACsADgAOAA4ADQANACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwBQAFAAUABQAFAAUABQAFAAUAArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAABAAEAAQABAAEAAQABAAEACsABAAEAAQABAAEAAQABAAEAFAADQANAA0ADQANACsAKwArACsAKwArACsAKwArACsASwBLAEsASwBLAEsASwBLAEsASwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArACsAKwAOABMAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAArAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAArACsAKwArACsAKwArACsAKwBQAFAAUABQAFAAUABQACsAUABQACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAEAAQABAAEAAQABAArACsAKwAEACsABAAEACsABAAEAAQABAAEAAQABABQAAQAKwArACsAKwArACsAKwArAEsASwBLAEsASwBLAEsASwBLAEsAKwArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAKwArACsAKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsADQANAA0ADQANACsAKwArACsAKwArACsAKwArACsAKwBQAFAAUABQACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAASABIAEgAQwBDAEMAUABQAFAAUABDAFAAUABQAEgAQwBIAEMAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAASABDAEMAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABIAEMAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArAEsASwBLAEsASwBLAEsASwBLAEsAKwArACsAKwANAA0AKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArAAQABAAEAAQABAANACsAKwArACsAKwArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAEAAQABAAEAAQABAAEAA0ADQANAB4AHgAeAB4AHgAeAFAAUABQAFAADQAeACsAKwArACsAKwArACsAKwArACsASwBLAEsASwBLAEsASwBLAEsASwArAFAAUABQAFAAUABQAFAAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArAFAAUABQAFAAUAArACsAKwArACsAKwArACsAKwArACsAUAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsABAAEAAQABABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAEcARwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwArACsAKwArACsAKwArACsAKwArACsAKwArAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAKwArACsAKwArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArACsAKwArACsAKwBQAFAAUABQAFAAUABQAFAAUABQACsAKwAeAAQABAANAAQABAAEAAQAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeACsAKwArACsAKwArACsAKwArACsAHgAeAB4AHgAeAB4AHgArACsAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4ABAAEAAQABAAEAB4AHgAeAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQAHgAeAAQABAAEAAQABAAEAAQAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAEAAQABAAEAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArAB4AHgAEAAQABAAeACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AKwArACsAKwArACsAKwArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAKwArACsAKwArACsAKwArACsAKwArACsAKwArAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeACsAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgArAFAAUAArACsAUAArACsAUABQACsAKwBQAFAAUABQACsAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AKwBQACsAUABQAFAAUABQAFAAUAArAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgArAFAAUABQAFAAKwArAFAAUABQAFAAUABQAFAAUAArAFAAUABQAFAAUABQAFAAKwAeAB4AUABQAFAAUABQACsAUAArACsAKwBQAFAAUABQAFAAUABQACsAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgArACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAAeAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAFAAUABQAFAAUABQAFAAUABQAFAAUAAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAHgAeAB4AHgAeAB4AHgAeAB4AKwArAEsASwBLAEsASwBLAEsASwBLAEsASwBLAEsASwBLAEsASwBLAEsASwBLAEsASwBLAEsASwBLAEsASwBLAEsASwBLAEsABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAB4AHgAeAB4ABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAB4AHgAeAB4AHgAeAB4AHgAEAB4AHgAeAB4AHgAeAB4AHgAeAB4ABAAeAB4ADQANAA0ADQAeACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArAAQABAAEAAQABAArAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsABAAEAAQABAAEAAQABAArAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAArACsABAAEAAQABAAEAAQABAArAAQABAArAAQABAAEAAQABAArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwBQAFAAUABQAFAAKwArAFAAUABQAFAAUABQAFAAUABQAAQABAAEAAQABAAEAAQAKwArACsAKwArACsAKwArACsAHgAeAB4AHgAEAAQABAAEAAQABAAEACsAKwArACsAKwBLAEsASwBLAEsASwBLAEsASwBLACsAKwArACsAFgAWAFAAUABQAFAAKwBQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArAFAAUAArAFAAKwArAFAAKwBQAFAAUABQAFAAUABQAFAAUABQACsAUABQAFAAUAArAFAAKwBQACsAKwArACsAKwArAFAAKwArACsAKwBQACsAUAArAFAAKwBQAFAAUAArAFAAUAArAFAAKwArAFAAKwBQACsAUAArAFAAKwBQACsAUABQACsAUAArACsAUABQAFAAUAArAFAAUABQAFAAUABQAFAAKwBQAFAAUABQACsAUABQAFAAUAArAFAAKwBQAFAAUABQAFAAUABQAFAAUABQACsAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQACsAKwArACsAKwBQAFAAUAArAFAAUABQAFAAUAArAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUABQAFAAUAArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArAB4AHgArACsAKwArACsAKwArACsAKwArACsAKwArACsATwBPAE8ATwBPAE8ATwBPAE8ATwBPAE8ATwAlACUAJQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAeACUAHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHgAeACUAJQAlACUAHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdAB0AHQAdACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACkAKQApACkAKQApACkAKQApACkAKQApACkAKQApACkAKQApACkAKQApACkAKQApACkAKQAlACUAJQAlACUAIAAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlAB4AHgAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAHgAeACUAJQAlACUAJQAeACUAJQAlACUAJQAgACAAIAAlACUAIAAlACUAIAAgACAAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAIQAhACEAIQAhACUAJQAgACAAJQAlACAAIAAgACAAIAAgACAAIAAgACAAIAAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAIAAgACAAIAAlACUAJQAlACAAJQAgACAAIAAgACAAIAAgACAAIAAlACUAJQAgACUAJQAlACUAIAAgACAAJQAgACAAIAAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAeACUAHgAlAB4AJQAlACUAJQAlACAAJQAlACUAJQAeACUAHgAeACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAHgAeAB4AHgAeAB4AHgAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlAB4AHgAeAB4AHgAeAB4AHgAeAB4AJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAIAAgACUAJQAlACUAIAAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAIAAlACUAJQAlACAAIAAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAeAB4AHgAeAB4AHgAeAB4AJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlAB4AHgAeAB4AHgAeACUAJQAlACUAJQAlACUAIAAgACAAJQAlACUAIAAgACAAIAAgAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AFwAXABcAFQAVABUAHgAeAB4AHgAlACUAJQAgACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAIAAgACAAJQAlACUAJQAlACUAJQAlACUAIAAlACUAJQAlACUAJQAlACUAJQAlACUAIAAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAlACUAJQAlACUAJQAlACUAJQAlACUAJQAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAlACUAJQAlAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AJQAlACUAJQAlACUAJQAlAB4AHgAeAB4AHgAeAB4AHgAeAB4AJQAlACUAJQAlACUAHgAeAB4AHgAeAB4AHgAeACUAJQAlACUAJQAlACUAJQAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeAB4AHgAeACUAJQAlACUAJQAlACUAJQAlACUAJQAlACAAIAAgACAAIAAlACAAIAAlACUAJQAlACUAJQAgACUAJQAlACUAJQAlACUAJQAlACAAIAAgACAAIAAgACAAIAAgACAAJQAlACUAIAAgACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACAAIAAgACAAIAAgACAAIAAgACAAIAAgACAAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACsAKwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAJQAlACUAJQAlACUAJQAlACUAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAJQAlACUAJQAlACUAJQAlACUAJQAlAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAVwBXAFcAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQAlACUAJQArAAQAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAAEAAQABAArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsAKwArACsA"),g=Array.isArray(m)?function(e){for(var t=e.length,r=[],n=0;n<t;n+=4)r.push(e[n+3]<<24|e[n+2]<<16|e[n+1]<<8|e[n]);return r}(m):new Uint32Array(m),y=Array.isArray(m)?function(e){for(var t=e.length,r=[],n=0;n<t;n+=2)r.push(e[n+1]<<8|e[n]);return r}(m):new Uint16Array(m),v=b(y,12,g[4]/2),w=2===g[5]?b(y,(24+g[4])/2):(f=g,h=Math.ceil((24+g[4])/4),f.slice?f.slice(h,p):new Uint32Array(Array.prototype.slice.call(f,h,p))),new B(g[0],g[1],g[2],g[3],v,w)),J=[P,36],Y=[1,2,3,5],Z=[j,8],$=[H,T],ee=Y.concat(Z),te=[K,z,V,R,M],re=[C,_],ne=function(e,t,r,n){var o=n[r];if(Array.isArray(e)?-1!==e.indexOf(o):e===o)for(var s=r;s<=n.length;){if((A=n[++s])===t)return!0;if(A!==j)break}if(o===j)for(s=r;s>0;){var i=n[--s];if(Array.isArray(e)?-1!==e.indexOf(i):e===i)for(var a=r;a<=n.length;){var A;if((A=n[++a])===t)return!0;if(A!==j)break}if(i!==j)break}return!1},oe=function(e,t){for(var r=e;r>=0;){var n=t[r];if(n!==j)return n;r--}return 0},se=function(e,t,r,n,o){if(0===r[n])return G;var s=n-1;if(Array.isArray(o)&&!0===o[s])return G;var i=s-1,a=s+1,A=t[s],u=i>=0?t[i]:0,c=t[a];if(2===A&&3===c)return G;if(-1!==Y.indexOf(A))return"!";if(-1!==Y.indexOf(c))return G;if(-1!==Z.indexOf(c))return G;if(8===oe(s,t))return X;if(11===W.get(e[s])&&(c===D||c===O||c===k))return G;if(7===A||7===c)return G;if(9===A)return G;if(-1===[j,_,C].indexOf(A)&&9===c)return G;if(-1!==[x,E,N,S,I].indexOf(c))return G;if(oe(s,t)===U)return G;if(ne(23,U,s,t))return G;if(ne([x,E],F,s,t))return G;if(ne(12,12,s,t))return G;if(A===j)return X;if(23===A||23===c)return G;if(16===c||16===A)return X;if(-1!==[_,C,F].indexOf(c)||14===A)return G;if(36===u&&-1!==re.indexOf(A))return G;if(A===I&&36===c)return G;if(c===Q&&-1!==J.concat(Q,N,L,D,O,k).indexOf(A))return G;if(-1!==J.indexOf(c)&&A===L||-1!==J.indexOf(A)&&c===L)return G;if(A===H&&-1!==[D,O,k].indexOf(c)||-1!==[D,O,k].indexOf(A)&&c===T)return G;if(-1!==J.indexOf(A)&&-1!==$.indexOf(c)||-1!==$.indexOf(A)&&-1!==J.indexOf(c))return G;if(-1!==[H,T].indexOf(A)&&(c===L||-1!==[U,C].indexOf(c)&&t[a+1]===L)||-1!==[U,C].indexOf(A)&&c===L||A===L&&-1!==[L,I,S].indexOf(c))return G;if(-1!==[L,I,S,x,E].indexOf(c))for(var l=s;l>=0;){if((d=t[l])===L)return G;if(-1===[I,S].indexOf(d))break;l--}if(-1!==[H,T].indexOf(c))for(l=-1!==[x,E].indexOf(A)?i:s;l>=0;){var d;if((d=t[l])===L)return G;if(-1===[I,S].indexOf(d))break;l--}if(K===A&&-1!==[K,z,R,M].indexOf(c)||-1!==[z,R].indexOf(A)&&-1!==[z,V].indexOf(c)||-1!==[V,M].indexOf(A)&&c===V)return G;if(-1!==te.indexOf(A)&&-1!==[Q,T].indexOf(c)||-1!==te.indexOf(c)&&A===H)return G;if(-1!==J.indexOf(A)&&-1!==J.indexOf(c))return G;if(A===S&&-1!==J.indexOf(c))return G;if(-1!==J.concat(L).indexOf(A)&&c===U||-1!==J.concat(L).indexOf(c)&&A===E)return G;if(41===A&&41===c){for(var f=r[s],h=1;f>0&&41===t[--f];)h++;if(h%2!=0)return G}return A===O&&c===k?G:X},ie=function(e,t){t||(t={lineBreak:"normal",wordBreak:"normal"});var r=function(e,t){void 0===t&&(t="strict");var r=[],n=[],o=[];return e.forEach((function(e,s){var i=W.get(e);if(i>50?(o.push(!0),i-=50):o.push(!1),-1!==["normal","auto","loose"].indexOf(t)&&-1!==[8208,8211,12316,12448].indexOf(e))return n.push(s),r.push(16);if(4===i||11===i){if(0===s)return n.push(s),r.push(P);var a=r[s-1];return-1===ee.indexOf(a)?(n.push(n[s-1]),r.push(a)):(n.push(s),r.push(P))}return n.push(s),31===i?r.push("strict"===t?F:D):i===q||29===i?r.push(P):43===i?e>=131072&&e<=196605||e>=196608&&e<=262141?r.push(D):r.push(P):void r.push(i)})),[n,r,o]}(e,t.lineBreak),n=r[0],o=r[1],s=r[2];return"break-all"!==t.wordBreak&&"break-word"!==t.wordBreak||(o=o.map((function(e){return-1!==[L,P,q].indexOf(e)?D:e}))),[n,o,"keep-all"===t.wordBreak?s.map((function(t,r){return t&&e[r]>=19968&&e[r]<=40959})):void 0]},ae=function(){function e(e,t,r,n){this.codePoints=e,this.required="!"===t,this.start=r,this.end=n}return e.prototype.slice=function(){return A.apply(void 0,this.codePoints.slice(this.start,this.end))},e}();!function(e){e[e.STRING_TOKEN=0]="STRING_TOKEN",e[e.BAD_STRING_TOKEN=1]="BAD_STRING_TOKEN",e[e.LEFT_PARENTHESIS_TOKEN=2]="LEFT_PARENTHESIS_TOKEN",e[e.RIGHT_PARENTHESIS_TOKEN=3]="RIGHT_PARENTHESIS_TOKEN",e[e.COMMA_TOKEN=4]="COMMA_TOKEN",e[e.HASH_TOKEN=5]="HASH_TOKEN",e[e.DELIM_TOKEN=6]="DELIM_TOKEN",e[e.AT_KEYWORD_TOKEN=7]="AT_KEYWORD_TOKEN",e[e.PREFIX_MATCH_TOKEN=8]="PREFIX_MATCH_TOKEN",e[e.DASH_MATCH_TOKEN=9]="DASH_MATCH_TOKEN",e[e.INCLUDE_MATCH_TOKEN=10]="INCLUDE_MATCH_TOKEN",e[e.LEFT_CURLY_BRACKET_TOKEN=11]="LEFT_CURLY_BRACKET_TOKEN",e[e.RIGHT_CURLY_BRACKET_TOKEN=12]="RIGHT_CURLY_BRACKET_TOKEN",e[e.SUFFIX_MATCH_TOKEN=13]="SUFFIX_MATCH_TOKEN",e[e.SUBSTRING_MATCH_TOKEN=14]="SUBSTRING_MATCH_TOKEN",e[e.DIMENSION_TOKEN=15]="DIMENSION_TOKEN",e[e.PERCENTAGE_TOKEN=16]="PERCENTAGE_TOKEN",e[e.NUMBER_TOKEN=17]="NUMBER_TOKEN",e[e.FUNCTION=18]="FUNCTION",e[e.FUNCTION_TOKEN=19]="FUNCTION_TOKEN",e[e.IDENT_TOKEN=20]="IDENT_TOKEN",e[e.COLUMN_TOKEN=21]="COLUMN_TOKEN",e[e.URL_TOKEN=22]="URL_TOKEN",e[e.BAD_URL_TOKEN=23]="BAD_URL_TOKEN",e[e.CDC_TOKEN=24]="CDC_TOKEN",e[e.CDO_TOKEN=25]="CDO_TOKEN",e[e.COLON_TOKEN=26]="COLON_TOKEN",e[e.SEMICOLON_TOKEN=27]="SEMICOLON_TOKEN",e[e.LEFT_SQUARE_BRACKET_TOKEN=28]="LEFT_SQUARE_BRACKET_TOKEN",e[e.RIGHT_SQUARE_BRACKET_TOKEN=29]="RIGHT_SQUARE_BRACKET_TOKEN",e[e.UNICODE_RANGE_TOKEN=30]="UNICODE_RANGE_TOKEN",e[e.WHITESPACE_TOKEN=31]="WHITESPACE_TOKEN",e[e.EOF_TOKEN=32]="EOF_TOKEN"}(d||(d={}));var Ae=45,ue=43,ce=-1,le=function(e){return e>=48&&e<=57},de=function(e){return le(e)||e>=65&&e<=70||e>=97&&e<=102},fe=function(e){return 10===e||9===e||32===e},he=function(e){return function(e){return function(e){return e>=97&&e<=122}(e)||function(e){return e>=65&&e<=90}(e)}(e)||function(e){return e>=128}(e)||95===e},pe=function(e){return he(e)||le(e)||e===Ae},me=function(e){return e>=0&&e<=8||11===e||e>=14&&e<=31||127===e},ge=function(e,t){return 92===e&&10!==t},ye=function(e,t,r){return e===Ae?he(t)||ge(t,r):!!he(e)||!(92!==e||!ge(e,t))},ve=function(e,t,r){return e===ue||e===Ae?!!le(t)||46===t&&le(r):le(46===e?t:e)},we=function(e){var t=0,r=1;e[t]!==ue&&e[t]!==Ae||(e[t]===Ae&&(r=-1),t++);for(var n=[];le(e[t]);)n.push(e[t++]);var o=n.length?parseInt(A.apply(void 0,n),10):0;46===e[t]&&t++;for(var s=[];le(e[t]);)s.push(e[t++]);var i=s.length,a=i?parseInt(A.apply(void 0,s),10):0;69!==e[t]&&101!==e[t]||t++;var u=1;e[t]!==ue&&e[t]!==Ae||(e[t]===Ae&&(u=-1),t++);for(var c=[];le(e[t]);)c.push(e[t++]);var l=c.length?parseInt(A.apply(void 0,c),10):0;return r*(o+a*Math.pow(10,-i))*Math.pow(10,u*l)},be={type:d.LEFT_PARENTHESIS_TOKEN},Be={type:d.RIGHT_PARENTHESIS_TOKEN},je={type:d.COMMA_TOKEN},_e={type:d.SUFFIX_MATCH_TOKEN},Ce={type:d.PREFIX_MATCH_TOKEN},xe={type:d.COLUMN_TOKEN},Ee={type:d.DASH_MATCH_TOKEN},Ne={type:d.INCLUDE_MATCH_TOKEN},Qe={type:d.LEFT_CURLY_BRACKET_TOKEN},Fe={type:d.RIGHT_CURLY_BRACKET_TOKEN},Ue={type:d.SUBSTRING_MATCH_TOKEN},Se={type:d.BAD_URL_TOKEN},Le={type:d.BAD_STRING_TOKEN},Te={type:d.CDO_TOKEN},He={type:d.CDC_TOKEN},Ie={type:d.COLON_TOKEN},Pe={type:d.SEMICOLON_TOKEN},Oe={type:d.LEFT_SQUARE_BRACKET_TOKEN},ke={type:d.RIGHT_SQUARE_BRACKET_TOKEN},Re={type:d.WHITESPACE_TOKEN},Me={type:d.EOF_TOKEN},De=function(){function e(){this._value=[]}return e.prototype.write=function(e){this._value=this._value.concat(a(e))},e.prototype.read=function(){for(var e=[],t=this.consumeToken();t!==Me;)e.push(t),t=this.consumeToken();return e},e.prototype.consumeToken=function(){var e=this.consumeCodePoint();switch(e){case 34:return this.consumeStringToken(34);case 35:var t=this.peekCodePoint(0),r=this.peekCodePoint(1),n=this.peekCodePoint(2);if(pe(t)||ge(r,n)){var o=ye(t,r,n)?2:1,s=this.consumeName();return{type:d.HASH_TOKEN,value:s,flags:o}}break;case 36:if(61===this.peekCodePoint(0))return this.consumeCodePoint(),_e;break;case 39:return this.consumeStringToken(39);case 40:return be;case 41:return Be;case 42:if(61===this.peekCodePoint(0))return this.consumeCodePoint(),Ue;break;case ue:if(ve(e,this.peekCodePoint(0),this.peekCodePoint(1)))return this.reconsumeCodePoint(e),this.consumeNumericToken();break;case 44:return je;case Ae:var i=e,a=this.peekCodePoint(0),u=this.peekCodePoint(1);if(ve(i,a,u))return this.reconsumeCodePoint(e),this.consumeNumericToken();if(ye(i,a,u))return this.reconsumeCodePoint(e),this.consumeIdentLikeToken();if(a===Ae&&62===u)return this.consumeCodePoint(),this.consumeCodePoint(),He;break;case 46:if(ve(e,this.peekCodePoint(0),this.peekCodePoint(1)))return this.reconsumeCodePoint(e),this.consumeNumericToken();break;case 47:if(42===this.peekCodePoint(0))for(this.consumeCodePoint();;){var c=this.consumeCodePoint();if(42===c&&47===(c=this.consumeCodePoint()))return this.consumeToken();if(c===ce)return this.consumeToken()}break;case 58:return Ie;case 59:return Pe;case 60:if(33===this.peekCodePoint(0)&&this.peekCodePoint(1)===Ae&&this.peekCodePoint(2)===Ae)return this.consumeCodePoint(),this.consumeCodePoint(),Te;break;case 64:var l=this.peekCodePoint(0),f=this.peekCodePoint(1),h=this.peekCodePoint(2);if(ye(l,f,h))return s=this.consumeName(),{type:d.AT_KEYWORD_TOKEN,value:s};break;case 91:return Oe;case 92:if(ge(e,this.peekCodePoint(0)))return this.reconsumeCodePoint(e),this.consumeIdentLikeToken();break;case 93:return ke;case 61:if(61===this.peekCodePoint(0))return this.consumeCodePoint(),Ce;break;case 123:return Qe;case 125:return Fe;case 117:case 85:var p=this.peekCodePoint(0),m=this.peekCodePoint(1);return p!==ue||!de(m)&&63!==m||(this.consumeCodePoint(),this.consumeUnicodeRangeToken()),this.reconsumeCodePoint(e),this.consumeIdentLikeToken();case 124:if(61===this.peekCodePoint(0))return this.consumeCodePoint(),Ee;if(124===this.peekCodePoint(0))return this.consumeCodePoint(),xe;break;case 126:if(61===this.peekCodePoint(0))return this.consumeCodePoint(),Ne;break;case ce:return Me}return fe(e)?(this.consumeWhiteSpace(),Re):le(e)?(this.reconsumeCodePoint(e),this.consumeNumericToken()):he(e)?(this.reconsumeCodePoint(e),this.consumeIdentLikeToken()):{type:d.DELIM_TOKEN,value:A(e)}},e.prototype.consumeCodePoint=function(){var e=this._value.shift();return void 0===e?-1:e},e.prototype.reconsumeCodePoint=function(e){this._value.unshift(e)},e.prototype.peekCodePoint=function(e){return e>=this._value.length?-1:this._value[e]},e.prototype.consumeUnicodeRangeToken=function(){for(var e=[],t=this.consumeCodePoint();de(t)&&e.length<6;)e.push(t),t=this.consumeCodePoint();for(var r=!1;63===t&&e.length<6;)e.push(t),t=this.consumeCodePoint(),r=!0;if(r){var n=parseInt(A.apply(void 0,e.map((function(e){return 63===e?48:e}))),16),o=parseInt(A.apply(void 0,e.map((function(e){return 63===e?70:e}))),16);return{type:d.UNICODE_RANGE_TOKEN,start:n,end:o}}var s=parseInt(A.apply(void 0,e),16);if(this.peekCodePoint(0)===Ae&&de(this.peekCodePoint(1))){this.consumeCodePoint(),t=this.consumeCodePoint();for(var i=[];de(t)&&i.length<6;)i.push(t),t=this.consumeCodePoint();return o=parseInt(A.apply(void 0,i),16),{type:d.UNICODE_RANGE_TOKEN,start:s,end:o}}return{type:d.UNICODE_RANGE_TOKEN,start:s,end:s}},e.prototype.consumeIdentLikeToken=function(){var e=this.consumeName();return"url"===e.toLowerCase()&&40===this.peekCodePoint(0)?(this.consumeCodePoint(),this.consumeUrlToken()):40===this.peekCodePoint(0)?(this.consumeCodePoint(),{type:d.FUNCTION_TOKEN,value:e}):{type:d.IDENT_TOKEN,value:e}},e.prototype.consumeUrlToken=function(){var e=[];if(this.consumeWhiteSpace(),this.peekCodePoint(0)===ce)return{type:d.URL_TOKEN,value:""};var t=this.peekCodePoint(0);if(39===t||34===t){var r=this.consumeStringToken(this.consumeCodePoint());return r.type===d.STRING_TOKEN&&(this.consumeWhiteSpace(),this.peekCodePoint(0)===ce||41===this.peekCodePoint(0))?(this.consumeCodePoint(),{type:d.URL_TOKEN,value:r.value}):(this.consumeBadUrlRemnants(),Se)}for(;;){var n=this.consumeCodePoint();if(n===ce||41===n)return{type:d.URL_TOKEN,value:A.apply(void 0,e)};if(fe(n))return this.consumeWhiteSpace(),this.peekCodePoint(0)===ce||41===this.peekCodePoint(0)?(this.consumeCodePoint(),{type:d.URL_TOKEN,value:A.apply(void 0,e)}):(this.consumeBadUrlRemnants(),Se);if(34===n||39===n||40===n||me(n))return this.consumeBadUrlRemnants(),Se;if(92===n){if(!ge(n,this.peekCodePoint(0)))return this.consumeBadUrlRemnants(),Se;e.push(this.consumeEscapedCodePoint())}else e.push(n)}},e.prototype.consumeWhiteSpace=function(){for(;fe(this.peekCodePoint(0));)this.consumeCodePoint()},e.prototype.consumeBadUrlRemnants=function(){for(;;){var e=this.consumeCodePoint();if(41===e||e===ce)return;ge(e,this.peekCodePoint(0))&&this.consumeEscapedCodePoint()}},e.prototype.consumeStringSlice=function(e){for(var t="";e>0;){var r=Math.min(6e4,e);t+=A.apply(void 0,this._value.splice(0,r)),e-=r}return this._value.shift(),t},e.prototype.consumeStringToken=function(e){for(var t="",r=0;;){var n=this._value[r];if(n===ce||void 0===n||n===e)return t+=this.consumeStringSlice(r),{type:d.STRING_TOKEN,value:t};if(10===n)return this._value.splice(0,r),Le;if(92===n){var o=this._value[r+1];o!==ce&&void 0!==o&&(10===o?(t+=this.consumeStringSlice(r),r=-1,this._value.shift()):ge(n,o)&&(t+=this.consumeStringSlice(r),t+=A(this.consumeEscapedCodePoint()),r=-1))}r++}},e.prototype.consumeNumber=function(){var e=[],t=4,r=this.peekCodePoint(0);for(r!==ue&&r!==Ae||e.push(this.consumeCodePoint());le(this.peekCodePoint(0));)e.push(this.consumeCodePoint());r=this.peekCodePoint(0);var n=this.peekCodePoint(1);if(46===r&&le(n))for(e.push(this.consumeCodePoint(),this.consumeCodePoint()),t=8;le(this.peekCodePoint(0));)e.push(this.consumeCodePoint());r=this.peekCodePoint(0),n=this.peekCodePoint(1);var o=this.peekCodePoint(2);if((69===r||101===r)&&((n===ue||n===Ae)&&le(o)||le(n)))for(e.push(this.consumeCodePoint(),this.consumeCodePoint()),t=8;le(this.peekCodePoint(0));)e.push(this.consumeCodePoint());return[we(e),t]},e.prototype.consumeNumericToken=function(){var e=this.consumeNumber(),t=e[0],r=e[1],n=this.peekCodePoint(0),o=this.peekCodePoint(1),s=this.peekCodePoint(2);if(ye(n,o,s)){var i=this.consumeName();return{type:d.DIMENSION_TOKEN,number:t,flags:r,unit:i}}return 37===n?(this.consumeCodePoint(),{type:d.PERCENTAGE_TOKEN,number:t,flags:r}):{type:d.NUMBER_TOKEN,number:t,flags:r}},e.prototype.consumeEscapedCodePoint=function(){var e=this.consumeCodePoint();if(de(e)){for(var t=A(e);de(this.peekCodePoint(0))&&t.length<6;)t+=A(this.consumeCodePoint());fe(this.peekCodePoint(0))&&this.consumeCodePoint();var r=parseInt(t,16);return 0===r||function(e){return e>=55296&&e<=57343}(r)||r>1114111?65533:r}return e===ce?65533:e},e.prototype.consumeName=function(){for(var e="";;){var t=this.consumeCodePoint();if(pe(t))e+=A(t);else{if(!ge(t,this.peekCodePoint(0)))return this.reconsumeCodePoint(t),e;e+=A(this.consumeEscapedCodePoint())}}},e}(),Ke=function(){function e(e){this._tokens=e}return e.create=function(t){var r=new De;return r.write(t),new e(r.read())},e.parseValue=function(t){return e.create(t).parseComponentValue()},e.parseValues=function(t){return e.create(t).parseComponentValues()},e.prototype.parseComponentValue=function(){for(var e=this.consumeToken();e.type===d.WHITESPACE_TOKEN;)e=this.consumeToken();if(e.type===d.EOF_TOKEN)throw new SyntaxError("Error parsing CSS component value, unexpected EOF");this.reconsumeToken(e);var t=this.consumeComponentValue();do{e=this.consumeToken()}while(e.type===d.WHITESPACE_TOKEN);if(e.type===d.EOF_TOKEN)return t;throw new SyntaxError("Error parsing CSS component value, multiple values found when expecting only one")},e.prototype.parseComponentValues=function(){for(var e=[];;){var t=this.consumeComponentValue();if(t.type===d.EOF_TOKEN)return e;e.push(t),e.push()}},e.prototype.consumeComponentValue=function(){var e=this.consumeToken();switch(e.type){case d.LEFT_CURLY_BRACKET_TOKEN:case d.LEFT_SQUARE_BRACKET_TOKEN:case d.LEFT_PARENTHESIS_TOKEN:return this.consumeSimpleBlock(e.type);case d.FUNCTION_TOKEN:return this.consumeFunction(e)}return e},e.prototype.consumeSimpleBlock=function(e){for(var t={type:e,values:[]},r=this.consumeToken();;){if(r.type===d.EOF_TOKEN||Ze(r,e))return t;this.reconsumeToken(r),t.values.push(this.consumeComponentValue()),r=this.consumeToken()}},e.prototype.consumeFunction=function(e){for(var t={name:e.value,values:[],type:d.FUNCTION};;){var r=this.consumeToken();if(r.type===d.EOF_TOKEN||r.type===d.RIGHT_PARENTHESIS_TOKEN)return t;this.reconsumeToken(r),t.values.push(this.consumeComponentValue())}},e.prototype.consumeToken=function(){var e=this._tokens.shift();return void 0===e?Me:e},e.prototype.reconsumeToken=function(e){this._tokens.unshift(e)},e}(),ze=function(e){return e.type===d.DIMENSION_TOKEN},Ve=function(e){return e.type===d.NUMBER_TOKEN},qe=function(e){return e.type===d.IDENT_TOKEN},Ge=function(e){return e.type===d.STRING_TOKEN},Xe=function(e,t){return qe(e)&&e.value===t},We=function(e){return e.type!==d.WHITESPACE_TOKEN},Je=function(e){return e.type!==d.WHITESPACE_TOKEN&&e.type!==d.COMMA_TOKEN},Ye=function(e){var t=[],r=[];return e.forEach((function(e){if(e.type===d.COMMA_TOKEN){if(0===r.length)throw new Error("Error parsing function args, zero tokens for arg");return t.push(r),void(r=[])}e.type!==d.WHITESPACE_TOKEN&&r.push(e)})),r.length&&t.push(r),t},Ze=function(e,t){return t===d.LEFT_CURLY_BRACKET_TOKEN&&e.type===d.RIGHT_CURLY_BRACKET_TOKEN||t===d.LEFT_SQUARE_BRACKET_TOKEN&&e.type===d.RIGHT_SQUARE_BRACKET_TOKEN||t===d.LEFT_PARENTHESIS_TOKEN&&e.type===d.RIGHT_PARENTHESIS_TOKEN},$e=function(e){return e.type===d.NUMBER_TOKEN||e.type===d.DIMENSION_TOKEN},et=function(e){return e.type===d.PERCENTAGE_TOKEN||$e(e)},tt=function(e){return e.length>1?[e[0],e[1]]:[e[0]]},rt={type:d.NUMBER_TOKEN,number:0,flags:4},nt={type:d.PERCENTAGE_TOKEN,number:50,flags:4},ot={type:d.PERCENTAGE_TOKEN,number:100,flags:4},st=function(e,t,r){var n=e[0],o=e[1];return[it(n,t),it(void 0!==o?o:n,r)]},it=function(e,t){if(e.type===d.PERCENTAGE_TOKEN)return e.number/100*t;if(ze(e))switch(e.unit){case"rem":case"em":return 16*e.number;case"px":default:return e.number}return e.number},at="grad",At="turn",ut=function(e){if(e.type===d.DIMENSION_TOKEN)switch(e.unit){case"deg":return Math.PI*e.number/180;case at:return Math.PI/200*e.number;case"rad":return e.number;case At:return 2*Math.PI*e.number}throw new Error("Unsupported angle type")},ct=function(e){return e.type===d.DIMENSION_TOKEN&&("deg"===e.unit||e.unit===at||"rad"===e.unit||e.unit===At)},lt=function(e){switch(e.filter(qe).map((function(e){return e.value})).join(" ")){case"to bottom right":case"to right bottom":case"left top":case"top left":return[rt,rt];case"to top":case"bottom":return dt(0);case"to bottom left":case"to left bottom":case"right top":case"top right":return[rt,ot];case"to right":case"left":return dt(90);case"to top left":case"to left top":case"right bottom":case"bottom right":return[ot,ot];case"to bottom":case"top":return dt(180);case"to top right":case"to right top":case"left bottom":case"bottom left":return[ot,rt];case"to left":case"right":return dt(270)}return 0},dt=function(e){return Math.PI*e/180},ft=function(e){if(e.type===d.FUNCTION){var t=jt[e.name];if(void 0===t)throw new Error('Attempting to parse an unsupported color function "'+e.name+'"');return t(e.values)}if(e.type===d.HASH_TOKEN){if(3===e.value.length){var r=e.value.substring(0,1),n=e.value.substring(1,2),o=e.value.substring(2,3);return mt(parseInt(r+r,16),parseInt(n+n,16),parseInt(o+o,16),1)}if(4===e.value.length){r=e.value.substring(0,1),n=e.value.substring(1,2),o=e.value.substring(2,3);var s=e.value.substring(3,4);return mt(parseInt(r+r,16),parseInt(n+n,16),parseInt(o+o,16),parseInt(s+s,16)/255)}if(6===e.value.length)return r=e.value.substring(0,2),n=e.value.substring(2,4),o=e.value.substring(4,6),mt(parseInt(r,16),parseInt(n,16),parseInt(o,16),1);if(8===e.value.length)return r=e.value.substring(0,2),n=e.value.substring(2,4),o=e.value.substring(4,6),s=e.value.substring(6,8),mt(parseInt(r,16),parseInt(n,16),parseInt(o,16),parseInt(s,16)/255)}if(e.type===d.IDENT_TOKEN){var i=_t[e.value.toUpperCase()];if(void 0!==i)return i}return _t.TRANSPARENT},ht=function(e){return 0==(255&e)},pt=function(e){var t=255&e,r=255&e>>8,n=255&e>>16,o=255&e>>24;return t<255?"rgba("+o+","+n+","+r+","+t/255+")":"rgb("+o+","+n+","+r+")"},mt=function(e,t,r,n){return(e<<24|t<<16|r<<8|Math.round(255*n)<<0)>>>0},gt=function(e,t){if(e.type===d.NUMBER_TOKEN)return e.number;if(e.type===d.PERCENTAGE_TOKEN){var r=3===t?1:255;return 3===t?e.number/100*r:Math.round(e.number/100*r)}return 0},yt=function(e){var t=e.filter(Je);if(3===t.length){var r=t.map(gt),n=r[0],o=r[1],s=r[2];return mt(n,o,s,1)}if(4===t.length){var i=t.map(gt),a=(n=i[0],o=i[1],s=i[2],i[3]);return mt(n,o,s,a)}return 0};function vt(e,t,r){return r<0&&(r+=1),r>=1&&(r-=1),r<1/6?(t-e)*r*6+e:r<.5?t:r<2/3?6*(t-e)*(2/3-r)+e:e}var wt,bt,Bt=function(e){var t=e.filter(Je),r=t[0],n=t[1],o=t[2],s=t[3],i=(r.type===d.NUMBER_TOKEN?dt(r.number):ut(r))/(2*Math.PI),a=et(n)?n.number/100:0,A=et(o)?o.number/100:0,u=void 0!==s&&et(s)?it(s,1):1;if(0===a)return mt(255*A,255*A,255*A,1);var c=A<=.5?A*(a+1):A+a-A*a,l=2*A-c,f=vt(l,c,i+1/3),h=vt(l,c,i),p=vt(l,c,i-1/3);return mt(255*f,255*h,255*p,u)},jt={hsl:Bt,hsla:Bt,rgb:yt,rgba:yt},_t={ALICEBLUE:4042850303,ANTIQUEWHITE:4209760255,AQUA:16777215,AQUAMARINE:2147472639,AZURE:4043309055,BEIGE:4126530815,BISQUE:4293182719,BLACK:255,BLANCHEDALMOND:4293643775,BLUE:65535,BLUEVIOLET:2318131967,BROWN:2771004159,BURLYWOOD:3736635391,CADETBLUE:1604231423,CHARTREUSE:2147418367,CHOCOLATE:3530104575,CORAL:4286533887,CORNFLOWERBLUE:1687547391,CORNSILK:4294499583,CRIMSON:3692313855,CYAN:16777215,DARKBLUE:35839,DARKCYAN:9145343,DARKGOLDENROD:3095837695,DARKGRAY:2846468607,DARKGREEN:6553855,DARKGREY:2846468607,DARKKHAKI:3182914559,DARKMAGENTA:2332068863,DARKOLIVEGREEN:1433087999,DARKORANGE:4287365375,DARKORCHID:2570243327,DARKRED:2332033279,DARKSALMON:3918953215,DARKSEAGREEN:2411499519,DARKSLATEBLUE:1211993087,DARKSLATEGRAY:793726975,DARKSLATEGREY:793726975,DARKTURQUOISE:13554175,DARKVIOLET:2483082239,DEEPPINK:4279538687,DEEPSKYBLUE:12582911,DIMGRAY:1768516095,DIMGREY:1768516095,DODGERBLUE:512819199,FIREBRICK:2988581631,FLORALWHITE:4294635775,FORESTGREEN:579543807,FUCHSIA:4278255615,GAINSBORO:3705462015,GHOSTWHITE:4177068031,GOLD:4292280575,GOLDENROD:3668254975,GRAY:2155905279,GREEN:8388863,GREENYELLOW:2919182335,GREY:2155905279,HONEYDEW:4043305215,HOTPINK:4285117695,INDIANRED:3445382399,INDIGO:1258324735,IVORY:4294963455,KHAKI:4041641215,LAVENDER:3873897215,LAVENDERBLUSH:4293981695,LAWNGREEN:2096890111,LEMONCHIFFON:4294626815,LIGHTBLUE:2916673279,LIGHTCORAL:4034953471,LIGHTCYAN:3774873599,LIGHTGOLDENRODYELLOW:4210742015,LIGHTGRAY:3553874943,LIGHTGREEN:2431553791,LIGHTGREY:3553874943,LIGHTPINK:4290167295,LIGHTSALMON:4288707327,LIGHTSEAGREEN:548580095,LIGHTSKYBLUE:2278488831,LIGHTSLATEGRAY:2005441023,LIGHTSLATEGREY:2005441023,LIGHTSTEELBLUE:2965692159,LIGHTYELLOW:4294959359,LIME:16711935,LIMEGREEN:852308735,LINEN:4210091775,MAGENTA:4278255615,MAROON:2147483903,MEDIUMAQUAMARINE:1724754687,MEDIUMBLUE:52735,MEDIUMORCHID:3126187007,MEDIUMPURPLE:2473647103,MEDIUMSEAGREEN:1018393087,MEDIUMSLATEBLUE:2070474495,MEDIUMSPRINGGREEN:16423679,MEDIUMTURQUOISE:1221709055,MEDIUMVIOLETRED:3340076543,MIDNIGHTBLUE:421097727,MINTCREAM:4127193855,MISTYROSE:4293190143,MOCCASIN:4293178879,NAVAJOWHITE:4292783615,NAVY:33023,OLDLACE:4260751103,OLIVE:2155872511,OLIVEDRAB:1804477439,ORANGE:4289003775,ORANGERED:4282712319,ORCHID:3664828159,PALEGOLDENROD:4008225535,PALEGREEN:2566625535,PALETURQUOISE:2951671551,PALEVIOLETRED:3681588223,PAPAYAWHIP:4293907967,PEACHPUFF:4292524543,PERU:3448061951,PINK:4290825215,PLUM:3718307327,POWDERBLUE:2967529215,PURPLE:2147516671,REBECCAPURPLE:1714657791,RED:4278190335,ROSYBROWN:3163525119,ROYALBLUE:1097458175,SADDLEBROWN:2336560127,SALMON:4202722047,SANDYBROWN:4104413439,SEAGREEN:780883967,SEASHELL:4294307583,SIENNA:2689740287,SILVER:3233857791,SKYBLUE:2278484991,SLATEBLUE:1784335871,SLATEGRAY:1887473919,SLATEGREY:1887473919,SNOW:4294638335,SPRINGGREEN:16744447,STEELBLUE:1182971135,TAN:3535047935,TEAL:8421631,THISTLE:3636451583,TOMATO:4284696575,TRANSPARENT:0,TURQUOISE:1088475391,VIOLET:4001558271,WHEAT:4125012991,WHITE:4294967295,WHITESMOKE:4126537215,YELLOW:4294902015,YELLOWGREEN:2597139199};(function(e){e[e.VALUE=0]="VALUE",e[e.LIST=1]="LIST",e[e.IDENT_VALUE=2]="IDENT_VALUE",e[e.TYPE_VALUE=3]="TYPE_VALUE",e[e.TOKEN_VALUE=4]="TOKEN_VALUE"})(wt||(wt={})),function(e){e[e.BORDER_BOX=0]="BORDER_BOX",e[e.PADDING_BOX=1]="PADDING_BOX",e[e.CONTENT_BOX=2]="CONTENT_BOX"}(bt||(bt={}));var Ct,xt={name:"background-clip",initialValue:"border-box",prefix:!1,type:wt.LIST,parse:function(e){return e.map((function(e){if(qe(e))switch(e.value){case"padding-box":return bt.PADDING_BOX;case"content-box":return bt.CONTENT_BOX}return bt.BORDER_BOX}))}},Et={name:"background-color",initialValue:"transparent",prefix:!1,type:wt.TYPE_VALUE,format:"color"},Nt=function(e){var t=ft(e[0]),r=e[1];return r&&et(r)?{color:t,stop:r}:{color:t,stop:null}},Qt=function(e,t){var r=e[0],n=e[e.length-1];null===r.stop&&(r.stop=rt),null===n.stop&&(n.stop=ot);for(var o=[],s=0,i=0;i<e.length;i++){var a=e[i].stop;if(null!==a){var A=it(a,t);A>s?o.push(A):o.push(s),s=A}else o.push(null)}var u=null;for(i=0;i<o.length;i++){var c=o[i];if(null===c)null===u&&(u=i);else if(null!==u){for(var l=i-u,d=(c-o[u-1])/(l+1),f=1;f<=l;f++)o[u+f-1]=d*f;u=null}}return e.map((function(e,r){return{color:e.color,stop:Math.max(Math.min(1,o[r]/t),0)}}))},Ft=function(e,t,r){var n="number"==typeof e?e:function(e,t,r){var n=t/2,o=r/2,s=it(e[0],t)-n,i=o-it(e[1],r);return(Math.atan2(i,s)+2*Math.PI)%(2*Math.PI)}(e,t,r),o=Math.abs(t*Math.sin(n))+Math.abs(r*Math.cos(n)),s=t/2,i=r/2,a=o/2,A=Math.sin(n-Math.PI/2)*a,u=Math.cos(n-Math.PI/2)*a;return[o,s-u,s+u,i-A,i+A]},Ut=function(e,t){return Math.sqrt(e*e+t*t)},St=function(e,t,r,n,o){return[[0,0],[0,t],[e,0],[e,t]].reduce((function(e,t){var s=t[0],i=t[1],a=Ut(r-s,n-i);return(o?a<e.optimumDistance:a>e.optimumDistance)?{optimumCorner:t,optimumDistance:a}:e}),{optimumDistance:o?1/0:-1/0,optimumCorner:null}).optimumCorner},Lt=function(e){var t=dt(180),r=[];return Ye(e).forEach((function(e,n){if(0===n){var o=e[0];if(o.type===d.IDENT_TOKEN&&-1!==["top","left","right","bottom"].indexOf(o.value))return void(t=lt(e));if(ct(o))return void(t=(ut(o)+dt(270))%dt(360))}var s=Nt(e);r.push(s)})),{angle:t,stops:r,type:Ct.LINEAR_GRADIENT}},Tt=function(e){return 0===e[0]&&255===e[1]&&0===e[2]&&255===e[3]},Ht=function(e,t,r,n,o){var s="http://www.w3.org/2000/svg",i=document.createElementNS(s,"svg"),a=document.createElementNS(s,"foreignObject");return i.setAttributeNS(null,"width",e.toString()),i.setAttributeNS(null,"height",t.toString()),a.setAttributeNS(null,"width","100%"),a.setAttributeNS(null,"height","100%"),a.setAttributeNS(null,"x",r.toString()),a.setAttributeNS(null,"y",n.toString()),a.setAttributeNS(null,"externalResourcesRequired","true"),i.appendChild(a),a.appendChild(o),i},It=function(e){return new Promise((function(t,r){var n=new Image;n.onload=function(){return t(n)},n.onerror=r,n.src="data:image/svg+xml;charset=utf-8,"+encodeURIComponent((new XMLSerializer).serializeToString(e))}))},Pt={get SUPPORT_RANGE_BOUNDS(){var e=function(e){if(e.createRange){var t=e.createRange();if(t.getBoundingClientRect){var r=e.createElement("boundtest");r.style.height="123px",r.style.display="block",e.body.appendChild(r),t.selectNode(r);var n=t.getBoundingClientRect(),o=Math.round(n.height);if(e.body.removeChild(r),123===o)return!0}}return!1}(document);return Object.defineProperty(Pt,"SUPPORT_RANGE_BOUNDS",{value:e}),e},get SUPPORT_SVG_DRAWING(){var e=function(e){var t=new Image,r=e.createElement("canvas"),n=r.getContext("2d");if(!n)return!1;t.src="data:image/svg+xml,<svg xmlns='http://www.w3.org/2000/svg'></svg>";try{n.drawImage(t,0,0),r.toDataURL()}catch(e){return!1}return!0}(document);return Object.defineProperty(Pt,"SUPPORT_SVG_DRAWING",{value:e}),e},get SUPPORT_FOREIGNOBJECT_DRAWING(){var e="function"==typeof Array.from&&"function"==typeof window.fetch?function(e){var t=e.createElement("canvas"),r=100;t.width=r,t.height=r;var n=t.getContext("2d");if(!n)return Promise.reject(!1);n.fillStyle="rgb(0, 255, 0)",n.fillRect(0,0,r,r);var o=new Image,s=t.toDataURL();o.src=s;var i=Ht(r,r,0,0,o);return n.fillStyle="red",n.fillRect(0,0,r,r),It(i).then((function(t){n.drawImage(t,0,0);var o=n.getImageData(0,0,r,r).data;n.fillStyle="red",n.fillRect(0,0,r,r);var i=e.createElement("div");return i.style.backgroundImage="url("+s+")",i.style.height="100px",Tt(o)?It(Ht(r,r,0,0,i)):Promise.reject(!1)})).then((function(e){return n.drawImage(e,0,0),Tt(n.getImageData(0,0,r,r).data)})).catch((function(){return!1}))}(document):Promise.resolve(!1);return Object.defineProperty(Pt,"SUPPORT_FOREIGNOBJECT_DRAWING",{value:e}),e},get SUPPORT_CORS_IMAGES(){var e=void 0!==(new Image).crossOrigin;return Object.defineProperty(Pt,"SUPPORT_CORS_IMAGES",{value:e}),e},get SUPPORT_RESPONSE_TYPE(){var e="string"==typeof(new XMLHttpRequest).responseType;return Object.defineProperty(Pt,"SUPPORT_RESPONSE_TYPE",{value:e}),e},get SUPPORT_CORS_XHR(){var e="withCredentials"in new XMLHttpRequest;return Object.defineProperty(Pt,"SUPPORT_CORS_XHR",{value:e}),e}},Ot=function(){function e(e){var t=e.id,r=e.enabled;this.id=t,this.enabled=r,this.start=Date.now()}return e.prototype.debug=function(){for(var e=[],t=0;t<arguments.length;t++)e[t]=arguments[t];this.enabled&&("undefined"!=typeof window&&window.console&&"function"==typeof console.debug?console.debug.apply(console,[this.id,this.getTime()+"ms"].concat(e)):this.info.apply(this,e))},e.prototype.getTime=function(){return Date.now()-this.start},e.create=function(t){e.instances[t.id]=new e(t)},e.destroy=function(t){delete e.instances[t]},e.getInstance=function(t){var r=e.instances[t];if(void 0===r)throw new Error("No logger instance found with id "+t);return r},e.prototype.info=function(){for(var e=[],t=0;t<arguments.length;t++)e[t]=arguments[t];this.enabled&&"undefined"!=typeof window&&window.console&&"function"==typeof console.info&&console.info.apply(console,[this.id,this.getTime()+"ms"].concat(e))},e.prototype.error=function(){for(var e=[],t=0;t<arguments.length;t++)e[t]=arguments[t];this.enabled&&("undefined"!=typeof window&&window.console&&"function"==typeof console.error?console.error.apply(console,[this.id,this.getTime()+"ms"].concat(e)):this.info.apply(this,e))},e.instances={},e}(),kt=function(){function e(){}return e.create=function(t,r){return e._caches[t]=new Rt(t,r)},e.destroy=function(t){delete e._caches[t]},e.open=function(t){var r=e._caches[t];if(void 0!==r)return r;throw new Error('Cache with key "'+t+'" not found')},e.getOrigin=function(t){var r=e._link;return r?(r.href=t,r.href=r.href,r.protocol+r.hostname+r.port):"about:blank"},e.isSameOrigin=function(t){return e.getOrigin(t)===e._origin},e.setContext=function(t){e._link=t.document.createElement("a"),e._origin=e.getOrigin(t.location.href)},e.getInstance=function(){var t=e._current;if(null===t)throw new Error("No cache instance attached");return t},e.attachInstance=function(t){e._current=t},e.detachInstance=function(){e._current=null},e._caches={},e._origin="about:blank",e._current=null,e}(),Rt=function(){function e(e,t){this.id=e,this._options=t,this._cache={}}return e.prototype.addImage=function(e){var t=Promise.resolve();return this.has(e)?t:Gt(e)||zt(e)?(this._cache[e]=this.loadImage(e),t):t},e.prototype.match=function(e){return this._cache[e]},e.prototype.loadImage=function(e){return n(this,void 0,void 0,(function(){var t,r,n,s,i=this;return o(this,(function(o){switch(o.label){case 0:return t=kt.isSameOrigin(e),r=!Vt(e)&&!0===this._options.useCORS&&Pt.SUPPORT_CORS_IMAGES&&!t,n=!Vt(e)&&!t&&"string"==typeof this._options.proxy&&Pt.SUPPORT_CORS_XHR&&!r,t||!1!==this._options.allowTaint||Vt(e)||n||r?(s=e,n?[4,this.proxy(s)]:[3,2]):[2];case 1:s=o.sent(),o.label=2;case 2:return Ot.getInstance(this.id).debug("Added image "+e.substring(0,256)),[4,new Promise((function(e,t){var n=new Image;n.onload=function(){return e(n)},n.onerror=t,(qt(s)||r)&&(n.crossOrigin="anonymous"),n.src=s,!0===n.complete&&setTimeout((function(){return e(n)}),500),i._options.imageTimeout>0&&setTimeout((function(){return t("Timed out ("+i._options.imageTimeout+"ms) loading image")}),i._options.imageTimeout)}))];case 3:return[2,o.sent()]}}))}))},e.prototype.has=function(e){return void 0!==this._cache[e]},e.prototype.keys=function(){return Promise.resolve(Object.keys(this._cache))},e.prototype.proxy=function(e){var t=this,r=this._options.proxy;if(!r)throw new Error("No proxy defined");var n=e.substring(0,256);return new Promise((function(o,s){var i=Pt.SUPPORT_RESPONSE_TYPE?"blob":"text",a=new XMLHttpRequest;if(a.onload=function(){if(200===a.status)if("text"===i)o(a.response);else{var e=new FileReader;e.addEventListener("load",(function(){return o(e.result)}),!1),e.addEventListener("error",(function(e){return s(e)}),!1),e.readAsDataURL(a.response)}else s("Failed to proxy resource "+n+" with status code "+a.status)},a.onerror=s,a.open("GET",r+"?url="+encodeURIComponent(e)+"&responseType="+i),"text"!==i&&a instanceof XMLHttpRequest&&(a.responseType=i),t._options.imageTimeout){var A=t._options.imageTimeout;a.timeout=A,a.ontimeout=function(){return s("Timed out ("+A+"ms) proxying "+n)}}a.send()}))},e}(),Mt=/^data:image\/svg\+xml/i,Dt=/^data:image\/.*;base64,/i,Kt=/^data:image\/.*/i,zt=function(e){return Pt.SUPPORT_SVG_DRAWING||!Xt(e)},Vt=function(e){return Kt.test(e)},qt=function(e){return Dt.test(e)},Gt=function(e){return"blob"===e.substr(0,4)},Xt=function(e){return"svg"===e.substr(-3).toLowerCase()||Mt.test(e)},Wt="closest-side",Jt="farthest-side",Yt="closest-corner",Zt="farthest-corner",$t="circle",er="ellipse",tr="cover",rr="contain",nr=function(e){var t=or.CIRCLE,r=sr.FARTHEST_CORNER,n=[],o=[];return Ye(e).forEach((function(e,s){var i=!0;if(0===s?i=e.reduce((function(e,t){if(qe(t))switch(t.value){case"center":return o.push(nt),!1;case"top":case"left":return o.push(rt),!1;case"right":case"bottom":return o.push(ot),!1}else if(et(t)||$e(t))return o.push(t),!1;return e}),i):1===s&&(i=e.reduce((function(e,n){if(qe(n))switch(n.value){case $t:return t=or.CIRCLE,!1;case er:return t=or.ELLIPSE,!1;case rr:case Wt:return r=sr.CLOSEST_SIDE,!1;case Jt:return r=sr.FARTHEST_SIDE,!1;case Yt:return r=sr.CLOSEST_CORNER,!1;case tr:case Zt:return r=sr.FARTHEST_CORNER,!1}else if($e(n)||et(n))return Array.isArray(r)||(r=[]),r.push(n),!1;return e}),i)),i){var a=Nt(e);n.push(a)}})),{size:r,shape:t,stops:n,position:o,type:Ct.RADIAL_GRADIENT}};!function(e){e[e.URL=0]="URL",e[e.LINEAR_GRADIENT=1]="LINEAR_GRADIENT",e[e.RADIAL_GRADIENT=2]="RADIAL_GRADIENT"}(Ct||(Ct={}));var or,sr;(function(e){e[e.CIRCLE=0]="CIRCLE",e[e.ELLIPSE=1]="ELLIPSE"})(or||(or={})),function(e){e[e.CLOSEST_SIDE=0]="CLOSEST_SIDE",e[e.FARTHEST_SIDE=1]="FARTHEST_SIDE",e[e.CLOSEST_CORNER=2]="CLOSEST_CORNER",e[e.FARTHEST_CORNER=3]="FARTHEST_CORNER"}(sr||(sr={}));var ir=function(e){if(e.type===d.URL_TOKEN){var t={url:e.value,type:Ct.URL};return kt.getInstance().addImage(e.value),t}if(e.type===d.FUNCTION){var r=Ar[e.name];if(void 0===r)throw new Error('Attempting to parse an unsupported image function "'+e.name+'"');return r(e.values)}throw new Error("Unsupported image type")};var ar,Ar={"linear-gradient":function(e){var t=dt(180),r=[];return Ye(e).forEach((function(e,n){if(0===n){var o=e[0];if(o.type===d.IDENT_TOKEN&&"to"===o.value)return void(t=lt(e));if(ct(o))return void(t=ut(o))}var s=Nt(e);r.push(s)})),{angle:t,stops:r,type:Ct.LINEAR_GRADIENT}},"-moz-linear-gradient":Lt,"-ms-linear-gradient":Lt,"-o-linear-gradient":Lt,"-webkit-linear-gradient":Lt,"radial-gradient":function(e){var t=or.CIRCLE,r=sr.FARTHEST_CORNER,n=[],o=[];return Ye(e).forEach((function(e,s){var i=!0;if(0===s){var a=!1;i=e.reduce((function(e,n){if(a)if(qe(n))switch(n.value){case"center":return o.push(nt),e;case"top":case"left":return o.push(rt),e;case"right":case"bottom":return o.push(ot),e}else(et(n)||$e(n))&&o.push(n);else if(qe(n))switch(n.value){case $t:return t=or.CIRCLE,!1;case er:return t=or.ELLIPSE,!1;case"at":return a=!0,!1;case Wt:return r=sr.CLOSEST_SIDE,!1;case tr:case Jt:return r=sr.FARTHEST_SIDE,!1;case rr:case Yt:return r=sr.CLOSEST_CORNER,!1;case Zt:return r=sr.FARTHEST_CORNER,!1}else if($e(n)||et(n))return Array.isArray(r)||(r=[]),r.push(n),!1;return e}),i)}if(i){var A=Nt(e);n.push(A)}})),{size:r,shape:t,stops:n,position:o,type:Ct.RADIAL_GRADIENT}},"-moz-radial-gradient":nr,"-ms-radial-gradient":nr,"-o-radial-gradient":nr,"-webkit-radial-gradient":nr,"-webkit-gradient":function(e){var t=dt(180),r=[],n=Ct.LINEAR_GRADIENT,o=or.CIRCLE,s=sr.FARTHEST_CORNER;return Ye(e).forEach((function(e,t){var o=e[0];if(0===t){if(qe(o)&&"linear"===o.value)return void(n=Ct.LINEAR_GRADIENT);if(qe(o)&&"radial"===o.value)return void(n=Ct.RADIAL_GRADIENT)}if(o.type===d.FUNCTION)if("from"===o.name){var s=ft(o.values[0]);r.push({stop:rt,color:s})}else if("to"===o.name)s=ft(o.values[0]),r.push({stop:ot,color:s});else if("color-stop"===o.name){var i=o.values.filter(Je);if(2===i.length){s=ft(i[1]);var a=i[0];Ve(a)&&r.push({stop:{type:d.PERCENTAGE_TOKEN,number:100*a.number,flags:a.flags},color:s})}}})),n===Ct.LINEAR_GRADIENT?{angle:(t+dt(180))%dt(360),stops:r,type:n}:{size:s,shape:o,stops:r,position:[],type:n}}},ur={name:"background-image",initialValue:"none",type:wt.LIST,prefix:!1,parse:function(e){if(0===e.length)return[];var t=e[0];return t.type===d.IDENT_TOKEN&&"none"===t.value?[]:e.filter((function(e){return Je(e)&&function(e){return e.type!==d.FUNCTION||Ar[e.name]}(e)})).map(ir)}},cr={name:"background-origin",initialValue:"border-box",prefix:!1,type:wt.LIST,parse:function(e){return e.map((function(e){if(qe(e))switch(e.value){case"padding-box":return 1;case"content-box":return 2}return 0}))}},lr={name:"background-position",initialValue:"0% 0%",type:wt.LIST,prefix:!1,parse:function(e){return Ye(e).map((function(e){return e.filter(et)})).map(tt)}};!function(e){e[e.REPEAT=0]="REPEAT",e[e.NO_REPEAT=1]="NO_REPEAT",e[e.REPEAT_X=2]="REPEAT_X",e[e.REPEAT_Y=3]="REPEAT_Y"}(ar||(ar={}));var dr,fr={name:"background-repeat",initialValue:"repeat",prefix:!1,type:wt.LIST,parse:function(e){return Ye(e).map((function(e){return e.filter(qe).map((function(e){return e.value})).join(" ")})).map(hr)}},hr=function(e){switch(e){case"no-repeat":return ar.NO_REPEAT;case"repeat-x":case"repeat no-repeat":return ar.REPEAT_X;case"repeat-y":case"no-repeat repeat":return ar.REPEAT_Y;case"repeat":default:return ar.REPEAT}};!function(e){e.AUTO="auto",e.CONTAIN="contain",e.COVER="cover"}(dr||(dr={}));var pr,mr={name:"background-size",initialValue:"0",prefix:!1,type:wt.LIST,parse:function(e){return Ye(e).map((function(e){return e.filter(gr)}))}},gr=function(e){return qe(e)||et(e)},yr=function(e){return{name:"border-"+e+"-color",initialValue:"transparent",prefix:!1,type:wt.TYPE_VALUE,format:"color"}},vr=yr("top"),wr=yr("right"),br=yr("bottom"),Br=yr("left"),jr=function(e){return{name:"border-radius-"+e,initialValue:"0 0",prefix:!1,type:wt.LIST,parse:function(e){return tt(e.filter(et))}}},_r=jr("top-left"),Cr=jr("top-right"),xr=jr("bottom-right"),Er=jr("bottom-left");!function(e){e[e.NONE=0]="NONE",e[e.SOLID=1]="SOLID",e[e.DASHED=2]="DASHED",e[e.DOTTED=3]="DOTTED",e[e.DOUBLE=4]="DOUBLE"}(pr||(pr={}));var Nr,Qr=function(e){return{name:"border-"+e+"-style",initialValue:"solid",prefix:!1,type:wt.IDENT_VALUE,parse:function(e){switch(e){case"none":return pr.NONE;case"dashed":return pr.DASHED;case"dotted":return pr.DOTTED;case"double":return pr.DOUBLE}return pr.SOLID}}},Fr=Qr("top"),Ur=Qr("right"),Sr=Qr("bottom"),Lr=Qr("left"),Tr=function(e){return{name:"border-"+e+"-width",initialValue:"0",type:wt.VALUE,prefix:!1,parse:function(e){return ze(e)?e.number:0}}},Hr=Tr("top"),Ir=Tr("right"),Pr=Tr("bottom"),Or=Tr("left"),kr={name:"color",initialValue:"transparent",prefix:!1,type:wt.TYPE_VALUE,format:"color"},Rr={name:"display",initialValue:"inline-block",prefix:!1,type:wt.LIST,parse:function(e){return e.filter(qe).reduce((function(e,t){return e|Mr(t.value)}),0)}},Mr=function(e){switch(e){case"block":case"-webkit-box":return 2;case"inline":return 4;case"run-in":return 8;case"flow":return 16;case"flow-root":return 32;case"table":return 64;case"flex":case"-webkit-flex":return 128;case"grid":case"-ms-grid":return 256;case"ruby":return 512;case"subgrid":return 1024;case"list-item":return 2048;case"table-row-group":return 4096;case"table-header-group":return 8192;case"table-footer-group":return 16384;case"table-row":return 32768;case"table-cell":return 65536;case"table-column-group":return 131072;case"table-column":return 262144;case"table-caption":return 524288;case"ruby-base":return 1048576;case"ruby-text":return 2097152;case"ruby-base-container":return 4194304;case"ruby-text-container":return 8388608;case"contents":return 16777216;case"inline-block":return 33554432;case"inline-list-item":return 67108864;case"inline-table":return 134217728;case"inline-flex":return 268435456;case"inline-grid":return 536870912}return 0};!function(e){e[e.NONE=0]="NONE",e[e.LEFT=1]="LEFT",e[e.RIGHT=2]="RIGHT",e[e.INLINE_START=3]="INLINE_START",e[e.INLINE_END=4]="INLINE_END"}(Nr||(Nr={}));var Dr,Kr={name:"float",initialValue:"none",prefix:!1,type:wt.IDENT_VALUE,parse:function(e){switch(e){case"left":return Nr.LEFT;case"right":return Nr.RIGHT;case"inline-start":return Nr.INLINE_START;case"inline-end":return Nr.INLINE_END}return Nr.NONE}},zr={name:"letter-spacing",initialValue:"0",prefix:!1,type:wt.VALUE,parse:function(e){return e.type===d.IDENT_TOKEN&&"normal"===e.value?0:e.type===d.NUMBER_TOKEN||e.type===d.DIMENSION_TOKEN?e.number:0}};!function(e){e.NORMAL="normal",e.STRICT="strict"}(Dr||(Dr={}));var Vr,qr={name:"line-break",initialValue:"normal",prefix:!1,type:wt.IDENT_VALUE,parse:function(e){switch(e){case"strict":return Dr.STRICT;case"normal":default:return Dr.NORMAL}}},Gr={name:"line-height",initialValue:"normal",prefix:!1,type:wt.TOKEN_VALUE},Xr={name:"list-style-image",initialValue:"none",type:wt.VALUE,prefix:!1,parse:function(e){return e.type===d.IDENT_TOKEN&&"none"===e.value?null:ir(e)}};!function(e){e[e.INSIDE=0]="INSIDE",e[e.OUTSIDE=1]="OUTSIDE"}(Vr||(Vr={}));var Wr,Jr={name:"list-style-position",initialValue:"outside",prefix:!1,type:wt.IDENT_VALUE,parse:function(e){switch(e){case"inside":return Vr.INSIDE;case"outside":default:return Vr.OUTSIDE}}};!function(e){e[e.NONE=-1]="NONE",e[e.DISC=0]="DISC",e[e.CIRCLE=1]="CIRCLE",e[e.SQUARE=2]="SQUARE",e[e.DECIMAL=3]="DECIMAL",e[e.CJK_DECIMAL=4]="CJK_DECIMAL",e[e.DECIMAL_LEADING_ZERO=5]="DECIMAL_LEADING_ZERO",e[e.LOWER_ROMAN=6]="LOWER_ROMAN",e[e.UPPER_ROMAN=7]="UPPER_ROMAN",e[e.LOWER_GREEK=8]="LOWER_GREEK",e[e.LOWER_ALPHA=9]="LOWER_ALPHA",e[e.UPPER_ALPHA=10]="UPPER_ALPHA",e[e.ARABIC_INDIC=11]="ARABIC_INDIC",e[e.ARMENIAN=12]="ARMENIAN",e[e.BENGALI=13]="BENGALI",e[e.CAMBODIAN=14]="CAMBODIAN",e[e.CJK_EARTHLY_BRANCH=15]="CJK_EARTHLY_BRANCH",e[e.CJK_HEAVENLY_STEM=16]="CJK_HEAVENLY_STEM",e[e.CJK_IDEOGRAPHIC=17]="CJK_IDEOGRAPHIC",e[e.DEVANAGARI=18]="DEVANAGARI",e[e.ETHIOPIC_NUMERIC=19]="ETHIOPIC_NUMERIC",e[e.GEORGIAN=20]="GEORGIAN",e[e.GUJARATI=21]="GUJARATI",e[e.GURMUKHI=22]="GURMUKHI",e[e.HEBREW=22]="HEBREW",e[e.HIRAGANA=23]="HIRAGANA",e[e.HIRAGANA_IROHA=24]="HIRAGANA_IROHA",e[e.JAPANESE_FORMAL=25]="JAPANESE_FORMAL",e[e.JAPANESE_INFORMAL=26]="JAPANESE_INFORMAL",e[e.KANNADA=27]="KANNADA",e[e.KATAKANA=28]="KATAKANA",e[e.KATAKANA_IROHA=29]="KATAKANA_IROHA",e[e.KHMER=30]="KHMER",e[e.KOREAN_HANGUL_FORMAL=31]="KOREAN_HANGUL_FORMAL",e[e.KOREAN_HANJA_FORMAL=32]="KOREAN_HANJA_FORMAL",e[e.KOREAN_HANJA_INFORMAL=33]="KOREAN_HANJA_INFORMAL",e[e.LAO=34]="LAO",e[e.LOWER_ARMENIAN=35]="LOWER_ARMENIAN",e[e.MALAYALAM=36]="MALAYALAM",e[e.MONGOLIAN=37]="MONGOLIAN",e[e.MYANMAR=38]="MYANMAR",e[e.ORIYA=39]="ORIYA",e[e.PERSIAN=40]="PERSIAN",e[e.SIMP_CHINESE_FORMAL=41]="SIMP_CHINESE_FORMAL",e[e.SIMP_CHINESE_INFORMAL=42]="SIMP_CHINESE_INFORMAL",e[e.TAMIL=43]="TAMIL",e[e.TELUGU=44]="TELUGU",e[e.THAI=45]="THAI",e[e.TIBETAN=46]="TIBETAN",e[e.TRAD_CHINESE_FORMAL=47]="TRAD_CHINESE_FORMAL",e[e.TRAD_CHINESE_INFORMAL=48]="TRAD_CHINESE_INFORMAL",e[e.UPPER_ARMENIAN=49]="UPPER_ARMENIAN",e[e.DISCLOSURE_OPEN=50]="DISCLOSURE_OPEN",e[e.DISCLOSURE_CLOSED=51]="DISCLOSURE_CLOSED"}(Wr||(Wr={}));var Yr,Zr={name:"list-style-type",initialValue:"none",prefix:!1,type:wt.IDENT_VALUE,parse:function(e){switch(e){case"disc":return Wr.DISC;case"circle":return Wr.CIRCLE;case"square":return Wr.SQUARE;case"decimal":return Wr.DECIMAL;case"cjk-decimal":return Wr.CJK_DECIMAL;case"decimal-leading-zero":return Wr.DECIMAL_LEADING_ZERO;case"lower-roman":return Wr.LOWER_ROMAN;case"upper-roman":return Wr.UPPER_ROMAN;case"lower-greek":return Wr.LOWER_GREEK;case"lower-alpha":return Wr.LOWER_ALPHA;case"upper-alpha":return Wr.UPPER_ALPHA;case"arabic-indic":return Wr.ARABIC_INDIC;case"armenian":return Wr.ARMENIAN;case"bengali":return Wr.BENGALI;case"cambodian":return Wr.CAMBODIAN;case"cjk-earthly-branch":return Wr.CJK_EARTHLY_BRANCH;case"cjk-heavenly-stem":return Wr.CJK_HEAVENLY_STEM;case"cjk-ideographic":return Wr.CJK_IDEOGRAPHIC;case"devanagari":return Wr.DEVANAGARI;case"ethiopic-numeric":return Wr.ETHIOPIC_NUMERIC;case"georgian":return Wr.GEORGIAN;case"gujarati":return Wr.GUJARATI;case"gurmukhi":return Wr.GURMUKHI;case"hebrew":return Wr.HEBREW;case"hiragana":return Wr.HIRAGANA;case"hiragana-iroha":return Wr.HIRAGANA_IROHA;case"japanese-formal":return Wr.JAPANESE_FORMAL;case"japanese-informal":return Wr.JAPANESE_INFORMAL;case"kannada":return Wr.KANNADA;case"katakana":return Wr.KATAKANA;case"katakana-iroha":return Wr.KATAKANA_IROHA;case"khmer":return Wr.KHMER;case"korean-hangul-formal":return Wr.KOREAN_HANGUL_FORMAL;case"korean-hanja-formal":return Wr.KOREAN_HANJA_FORMAL;case"korean-hanja-informal":return Wr.KOREAN_HANJA_INFORMAL;case"lao":return Wr.LAO;case"lower-armenian":return Wr.LOWER_ARMENIAN;case"malayalam":return Wr.MALAYALAM;case"mongolian":return Wr.MONGOLIAN;case"myanmar":return Wr.MYANMAR;case"oriya":return Wr.ORIYA;case"persian":return Wr.PERSIAN;case"simp-chinese-formal":return Wr.SIMP_CHINESE_FORMAL;case"simp-chinese-informal":return Wr.SIMP_CHINESE_INFORMAL;case"tamil":return Wr.TAMIL;case"telugu":return Wr.TELUGU;case"thai":return Wr.THAI;case"tibetan":return Wr.TIBETAN;case"trad-chinese-formal":return Wr.TRAD_CHINESE_FORMAL;case"trad-chinese-informal":return Wr.TRAD_CHINESE_INFORMAL;case"upper-armenian":return Wr.UPPER_ARMENIAN;case"disclosure-open":return Wr.DISCLOSURE_OPEN;case"disclosure-closed":return Wr.DISCLOSURE_CLOSED;case"none":default:return Wr.NONE}}},$r=function(e){return{name:"margin-"+e,initialValue:"0",prefix:!1,type:wt.TOKEN_VALUE}},en=$r("top"),tn=$r("right"),rn=$r("bottom"),nn=$r("left");!function(e){e[e.VISIBLE=0]="VISIBLE",e[e.HIDDEN=1]="HIDDEN",e[e.SCROLL=2]="SCROLL",e[e.AUTO=3]="AUTO"}(Yr||(Yr={}));var on,sn={name:"overflow",initialValue:"visible",prefix:!1,type:wt.LIST,parse:function(e){return e.filter(qe).map((function(e){switch(e.value){case"hidden":return Yr.HIDDEN;case"scroll":return Yr.SCROLL;case"auto":return Yr.AUTO;case"visible":default:return Yr.VISIBLE}}))}};!function(e){e.NORMAL="normal",e.BREAK_WORD="break-word"}(on||(on={}));var an,An={name:"overflow-wrap",initialValue:"normal",prefix:!1,type:wt.IDENT_VALUE,parse:function(e){switch(e){case"break-word":return on.BREAK_WORD;case"normal":default:return on.NORMAL}}},un=function(e){return{name:"padding-"+e,initialValue:"0",prefix:!1,type:wt.TYPE_VALUE,format:"length-percentage"}},cn=un("top"),ln=un("right"),dn=un("bottom"),fn=un("left");!function(e){e[e.LEFT=0]="LEFT",e[e.CENTER=1]="CENTER",e[e.RIGHT=2]="RIGHT"}(an||(an={}));var hn,pn={name:"text-align",initialValue:"left",prefix:!1,type:wt.IDENT_VALUE,parse:function(e){switch(e){case"right":return an.RIGHT;case"center":case"justify":return an.CENTER;case"left":default:return an.LEFT}}};!function(e){e[e.STATIC=0]="STATIC",e[e.RELATIVE=1]="RELATIVE",e[e.ABSOLUTE=2]="ABSOLUTE",e[e.FIXED=3]="FIXED",e[e.STICKY=4]="STICKY"}(hn||(hn={}));var mn,gn={name:"position",initialValue:"static",prefix:!1,type:wt.IDENT_VALUE,parse:function(e){switch(e){case"relative":return hn.RELATIVE;case"absolute":return hn.ABSOLUTE;case"fixed":return hn.FIXED;case"sticky":return hn.STICKY}return hn.STATIC}},yn={name:"text-shadow",initialValue:"none",type:wt.LIST,prefix:!1,parse:function(e){return 1===e.length&&Xe(e[0],"none")?[]:Ye(e).map((function(e){for(var t={color:_t.TRANSPARENT,offsetX:rt,offsetY:rt,blur:rt},r=0,n=0;n<e.length;n++){var o=e[n];$e(o)?(0===r?t.offsetX=o:1===r?t.offsetY=o:t.blur=o,r++):t.color=ft(o)}return t}))}};!function(e){e[e.NONE=0]="NONE",e[e.LOWERCASE=1]="LOWERCASE",e[e.UPPERCASE=2]="UPPERCASE",e[e.CAPITALIZE=3]="CAPITALIZE"}(mn||(mn={}));var vn,wn={name:"text-transform",initialValue:"none",prefix:!1,type:wt.IDENT_VALUE,parse:function(e){switch(e){case"uppercase":return mn.UPPERCASE;case"lowercase":return mn.LOWERCASE;case"capitalize":return mn.CAPITALIZE}return mn.NONE}},bn={name:"transform",initialValue:"none",prefix:!0,type:wt.VALUE,parse:function(e){if(e.type===d.IDENT_TOKEN&&"none"===e.value)return null;if(e.type===d.FUNCTION){var t=Bn[e.name];if(void 0===t)throw new Error('Attempting to parse an unsupported transform function "'+e.name+'"');return t(e.values)}return null}},Bn={matrix:function(e){var t=e.filter((function(e){return e.type===d.NUMBER_TOKEN})).map((function(e){return e.number}));return 6===t.length?t:null},matrix3d:function(e){var t=e.filter((function(e){return e.type===d.NUMBER_TOKEN})).map((function(e){return e.number})),r=t[0],n=t[1],o=(t[2],t[3],t[4]),s=t[5],i=(t[6],t[7],t[8],t[9],t[10],t[11],t[12]),a=t[13];return t[14],t[15],16===t.length?[r,n,o,s,i,a]:null}},jn={type:d.PERCENTAGE_TOKEN,number:50,flags:4},_n=[jn,jn],Cn={name:"transform-origin",initialValue:"50% 50%",prefix:!0,type:wt.LIST,parse:function(e){var t=e.filter(et);return 2!==t.length?_n:[t[0],t[1]]}};!function(e){e[e.VISIBLE=0]="VISIBLE",e[e.HIDDEN=1]="HIDDEN",e[e.COLLAPSE=2]="COLLAPSE"}(vn||(vn={}));var xn,En={name:"visible",initialValue:"none",prefix:!1,type:wt.IDENT_VALUE,parse:function(e){switch(e){case"hidden":return vn.HIDDEN;case"collapse":return vn.COLLAPSE;case"visible":default:return vn.VISIBLE}}};!function(e){e.NORMAL="normal",e.BREAK_ALL="break-all",e.KEEP_ALL="keep-all"}(xn||(xn={}));var Nn,Qn={name:"word-break",initialValue:"normal",prefix:!1,type:wt.IDENT_VALUE,parse:function(e){switch(e){case"break-all":return xn.BREAK_ALL;case"keep-all":return xn.KEEP_ALL;case"normal":default:return xn.NORMAL}}},Fn={name:"z-index",initialValue:"auto",prefix:!1,type:wt.VALUE,parse:function(e){if(e.type===d.IDENT_TOKEN)return{auto:!0,order:0};if(Ve(e))return{auto:!1,order:e.number};throw new Error("Invalid z-index number parsed")}},Un={name:"opacity",initialValue:"1",type:wt.VALUE,prefix:!1,parse:function(e){return Ve(e)?e.number:1}},Sn={name:"text-decoration-color",initialValue:"transparent",prefix:!1,type:wt.TYPE_VALUE,format:"color"},Ln={name:"text-decoration-line",initialValue:"none",prefix:!1,type:wt.LIST,parse:function(e){return e.filter(qe).map((function(e){switch(e.value){case"underline":return 1;case"overline":return 2;case"line-through":return 3;case"none":return 4}return 0})).filter((function(e){return 0!==e}))}},Tn={name:"font-family",initialValue:"",prefix:!1,type:wt.LIST,parse:function(e){var t=[],r=[];return e.forEach((function(e){switch(e.type){case d.IDENT_TOKEN:case d.STRING_TOKEN:t.push(e.value);break;case d.NUMBER_TOKEN:t.push(e.number.toString());break;case d.COMMA_TOKEN:r.push(t.join(" ")),t.length=0}})),t.length&&r.push(t.join(" ")),r.map((function(e){return-1===e.indexOf(" ")?e:"'"+e+"'"}))}},Hn={name:"font-size",initialValue:"0",prefix:!1,type:wt.TYPE_VALUE,format:"length"},In={name:"font-weight",initialValue:"normal",type:wt.VALUE,prefix:!1,parse:function(e){if(Ve(e))return e.number;if(qe(e))switch(e.value){case"bold":return 700;case"normal":default:return 400}return 400}},Pn={name:"font-variant",initialValue:"none",type:wt.LIST,prefix:!1,parse:function(e){return e.filter(qe).map((function(e){return e.value}))}};!function(e){e.NORMAL="normal",e.ITALIC="italic",e.OBLIQUE="oblique"}(Nn||(Nn={}));var On,kn={name:"font-style",initialValue:"normal",prefix:!1,type:wt.IDENT_VALUE,parse:function(e){switch(e){case"oblique":return Nn.OBLIQUE;case"italic":return Nn.ITALIC;case"normal":default:return Nn.NORMAL}}},Rn=function(e,t){return 0!=(e&t)},Mn={name:"content",initialValue:"none",type:wt.LIST,prefix:!1,parse:function(e){if(0===e.length)return[];var t=e[0];return t.type===d.IDENT_TOKEN&&"none"===t.value?[]:e}},Dn={name:"counter-increment",initialValue:"none",prefix:!0,type:wt.LIST,parse:function(e){if(0===e.length)return null;var t=e[0];if(t.type===d.IDENT_TOKEN&&"none"===t.value)return null;for(var r=[],n=e.filter(We),o=0;o<n.length;o++){var s=n[o],i=n[o+1];if(s.type===d.IDENT_TOKEN){var a=i&&Ve(i)?i.number:1;r.push({counter:s.value,increment:a})}}return r}},Kn={name:"counter-reset",initialValue:"none",prefix:!0,type:wt.LIST,parse:function(e){if(0===e.length)return[];for(var t=[],r=e.filter(We),n=0;n<r.length;n++){var o=r[n],s=r[n+1];if(qe(o)&&"none"!==o.value){var i=s&&Ve(s)?s.number:0;t.push({counter:o.value,reset:i})}}return t}},zn={name:"quotes",initialValue:"none",prefix:!0,type:wt.LIST,parse:function(e){if(0===e.length)return null;var t=e[0];if(t.type===d.IDENT_TOKEN&&"none"===t.value)return null;var r=[],n=e.filter(Ge);if(n.length%2!=0)return null;for(var o=0;o<n.length;o+=2){var s=n[o].value,i=n[o+1].value;r.push({open:s,close:i})}return r}},Vn=function(e,t,r){if(!e)return"";var n=e[Math.min(t,e.length-1)];return n?r?n.open:n.close:""},qn={name:"box-shadow",initialValue:"none",type:wt.LIST,prefix:!1,parse:function(e){return 1===e.length&&Xe(e[0],"none")?[]:Ye(e).map((function(e){for(var t={color:255,offsetX:rt,offsetY:rt,blur:rt,spread:rt,inset:!1},r=0,n=0;n<e.length;n++){var o=e[n];Xe(o,"inset")?t.inset=!0:$e(o)?(0===r?t.offsetX=o:1===r?t.offsetY=o:2===r?t.blur=o:t.spread=o,r++):t.color=ft(o)}return t}))}},Gn=function(){function e(e){this.backgroundClip=Jn(xt,e.backgroundClip),this.backgroundColor=Jn(Et,e.backgroundColor),this.backgroundImage=Jn(ur,e.backgroundImage),this.backgroundOrigin=Jn(cr,e.backgroundOrigin),this.backgroundPosition=Jn(lr,e.backgroundPosition),this.backgroundRepeat=Jn(fr,e.backgroundRepeat),this.backgroundSize=Jn(mr,e.backgroundSize),this.borderTopColor=Jn(vr,e.borderTopColor),this.borderRightColor=Jn(wr,e.borderRightColor),this.borderBottomColor=Jn(br,e.borderBottomColor),this.borderLeftColor=Jn(Br,e.borderLeftColor),this.borderTopLeftRadius=Jn(_r,e.borderTopLeftRadius),this.borderTopRightRadius=Jn(Cr,e.borderTopRightRadius),this.borderBottomRightRadius=Jn(xr,e.borderBottomRightRadius),this.borderBottomLeftRadius=Jn(Er,e.borderBottomLeftRadius),this.borderTopStyle=Jn(Fr,e.borderTopStyle),this.borderRightStyle=Jn(Ur,e.borderRightStyle),this.borderBottomStyle=Jn(Sr,e.borderBottomStyle),this.borderLeftStyle=Jn(Lr,e.borderLeftStyle),this.borderTopWidth=Jn(Hr,e.borderTopWidth),this.borderRightWidth=Jn(Ir,e.borderRightWidth),this.borderBottomWidth=Jn(Pr,e.borderBottomWidth),this.borderLeftWidth=Jn(Or,e.borderLeftWidth),this.boxShadow=Jn(qn,e.boxShadow),this.color=Jn(kr,e.color),this.display=Jn(Rr,e.display),this.float=Jn(Kr,e.cssFloat),this.fontFamily=Jn(Tn,e.fontFamily),this.fontSize=Jn(Hn,e.fontSize),this.fontStyle=Jn(kn,e.fontStyle),this.fontVariant=Jn(Pn,e.fontVariant),this.fontWeight=Jn(In,e.fontWeight),this.letterSpacing=Jn(zr,e.letterSpacing),this.lineBreak=Jn(qr,e.lineBreak),this.lineHeight=Jn(Gr,e.lineHeight),this.listStyleImage=Jn(Xr,e.listStyleImage),this.listStylePosition=Jn(Jr,e.listStylePosition),this.listStyleType=Jn(Zr,e.listStyleType),this.marginTop=Jn(en,e.marginTop),this.marginRight=Jn(tn,e.marginRight),this.marginBottom=Jn(rn,e.marginBottom),this.marginLeft=Jn(nn,e.marginLeft),this.opacity=Jn(Un,e.opacity);var t=Jn(sn,e.overflow);this.overflowX=t[0],this.overflowY=t[t.length>1?1:0],this.overflowWrap=Jn(An,e.overflowWrap),this.paddingTop=Jn(cn,e.paddingTop),this.paddingRight=Jn(ln,e.paddingRight),this.paddingBottom=Jn(dn,e.paddingBottom),this.paddingLeft=Jn(fn,e.paddingLeft),this.position=Jn(gn,e.position),this.textAlign=Jn(pn,e.textAlign),this.textDecorationColor=Jn(Sn,e.textDecorationColor||e.color),this.textDecorationLine=Jn(Ln,e.textDecorationLine),this.textShadow=Jn(yn,e.textShadow),this.textTransform=Jn(wn,e.textTransform),this.transform=Jn(bn,e.transform),this.transformOrigin=Jn(Cn,e.transformOrigin),this.visibility=Jn(En,e.visibility),this.wordBreak=Jn(Qn,e.wordBreak),this.zIndex=Jn(Fn,e.zIndex)}return e.prototype.isVisible=function(){return this.display>0&&this.opacity>0&&this.visibility===vn.VISIBLE},e.prototype.isTransparent=function(){return ht(this.backgroundColor)},e.prototype.isTransformed=function(){return null!==this.transform},e.prototype.isPositioned=function(){return this.position!==hn.STATIC},e.prototype.isPositionedWithZIndex=function(){return this.isPositioned()&&!this.zIndex.auto},e.prototype.isFloating=function(){return this.float!==Nr.NONE},e.prototype.isInlineLevel=function(){return Rn(this.display,4)||Rn(this.display,33554432)||Rn(this.display,268435456)||Rn(this.display,536870912)||Rn(this.display,67108864)||Rn(this.display,134217728)},e}(),Xn=function(e){this.content=Jn(Mn,e.content),this.quotes=Jn(zn,e.quotes)},Wn=function(e){this.counterIncrement=Jn(Dn,e.counterIncrement),this.counterReset=Jn(Kn,e.counterReset)},Jn=function(e,t){var r=new De,n=null!=t?t.toString():e.initialValue;r.write(n);var o=new Ke(r.read());switch(e.type){case wt.IDENT_VALUE:var s=o.parseComponentValue();return e.parse(qe(s)?s.value:e.initialValue);case wt.VALUE:return e.parse(o.parseComponentValue());case wt.LIST:return e.parse(o.parseComponentValues());case wt.TOKEN_VALUE:return o.parseComponentValue();case wt.TYPE_VALUE:switch(e.format){case"angle":return ut(o.parseComponentValue());case"color":return ft(o.parseComponentValue());case"image":return ir(o.parseComponentValue());case"length":var i=o.parseComponentValue();return $e(i)?i:rt;case"length-percentage":var a=o.parseComponentValue();return et(a)?a:rt}}throw new Error("Attempting to parse unsupported css format type "+e.format)},Yn=function(e){this.styles=new Gn(window.getComputedStyle(e,null)),this.textNodes=[],this.elements=[],null!==this.styles.transform&&So(e)&&(e.style.transform="none"),this.bounds=i(e),this.flags=0},Zn=function(e,t){this.text=e,this.bounds=t},$n=function(e){var t=e.ownerDocument;if(t){var r=t.createElement("html2canvaswrapper");r.appendChild(e.cloneNode(!0));var n=e.parentNode;if(n){n.replaceChild(r,e);var o=i(r);return r.firstChild&&n.replaceChild(r.firstChild,r),o}}return new s(0,0,0,0)},eo=function(e,t,r){var n=e.ownerDocument;if(!n)throw new Error("Node has no owner document");var o=n.createRange();return o.setStart(e,t),o.setEnd(e,t+r),s.fromClientRect(o.getBoundingClientRect())},to=function(e,t){return 0!==t.letterSpacing?a(e).map((function(e){return A(e)})):ro(e,t)},ro=function(e,t){for(var r,n=function(e,t){var r=a(e),n=ie(r,t),o=n[0],s=n[1],i=n[2],A=r.length,u=0,c=0;return{next:function(){if(c>=A)return{done:!0,value:null};for(var e=G;c<A&&(e=se(r,s,o,++c,i))===G;);if(e!==G||c===A){var t=new ae(r,e,u,c);return u=c,{value:t,done:!1}}return{done:!0,value:null}}}}(e,{lineBreak:t.lineBreak,wordBreak:t.overflowWrap===on.BREAK_WORD?"break-word":t.wordBreak}),o=[];!(r=n.next()).done;)r.value&&o.push(r.value.slice());return o},no=function(e,t){this.text=oo(e.data,t.textTransform),this.textBounds=function(e,t,r){var n=to(e,t),o=[],s=0;return n.forEach((function(e){if(t.textDecorationLine.length||e.trim().length>0)if(Pt.SUPPORT_RANGE_BOUNDS)o.push(new Zn(e,eo(r,s,e.length)));else{var n=r.splitText(e.length);o.push(new Zn(e,$n(r))),r=n}else Pt.SUPPORT_RANGE_BOUNDS||(r=r.splitText(e.length));s+=e.length})),o}(this.text,t,e)},oo=function(e,t){switch(t){case mn.LOWERCASE:return e.toLowerCase();case mn.CAPITALIZE:return e.replace(so,io);case mn.UPPERCASE:return e.toUpperCase();default:return e}},so=/(^|\s|:|-|\(|\))([a-z])/g,io=function(e,t,r){return e.length>0?t+r.toUpperCase():e},ao=function(e){function r(t){var r=e.call(this,t)||this;return r.src=t.currentSrc||t.src,r.intrinsicWidth=t.naturalWidth,r.intrinsicHeight=t.naturalHeight,kt.getInstance().addImage(r.src),r}return t(r,e),r}(Yn),Ao=function(e){function r(t){var r=e.call(this,t)||this;return r.canvas=t,r.intrinsicWidth=t.width,r.intrinsicHeight=t.height,r}return t(r,e),r}(Yn),uo=function(e){function r(t){var r=e.call(this,t)||this,n=new XMLSerializer;return r.svg="data:image/svg+xml,"+encodeURIComponent(n.serializeToString(t)),r.intrinsicWidth=t.width.baseVal.value,r.intrinsicHeight=t.height.baseVal.value,kt.getInstance().addImage(r.svg),r}return t(r,e),r}(Yn),co=function(e){function r(t){var r=e.call(this,t)||this;return r.value=t.value,r}return t(r,e),r}(Yn),lo=function(e){function r(t){var r=e.call(this,t)||this;return r.start=t.start,r.reversed="boolean"==typeof t.reversed&&!0===t.reversed,r}return t(r,e),r}(Yn),fo=[{type:d.DIMENSION_TOKEN,flags:0,unit:"px",number:3}],ho=[{type:d.PERCENTAGE_TOKEN,flags:0,number:50}],po="checkbox",mo="radio",go="password",yo=707406591,vo=function(e){function r(t){var r,n,o,i=e.call(this,t)||this;switch(i.type=t.type.toLowerCase(),i.checked=t.checked,i.value=0===(o=(n=t).type===go?new Array(n.value.length+1).join("•"):n.value).length?n.placeholder||"":o,i.type!==po&&i.type!==mo||(i.styles.backgroundColor=3739148031,i.styles.borderTopColor=i.styles.borderRightColor=i.styles.borderBottomColor=i.styles.borderLeftColor=2779096575,i.styles.borderTopWidth=i.styles.borderRightWidth=i.styles.borderBottomWidth=i.styles.borderLeftWidth=1,i.styles.borderTopStyle=i.styles.borderRightStyle=i.styles.borderBottomStyle=i.styles.borderLeftStyle=pr.SOLID,i.styles.backgroundClip=[bt.BORDER_BOX],i.styles.backgroundOrigin=[0],i.bounds=(r=i.bounds).width>r.height?new s(r.left+(r.width-r.height)/2,r.top,r.height,r.height):r.width<r.height?new s(r.left,r.top+(r.height-r.width)/2,r.width,r.width):r),i.type){case po:i.styles.borderTopRightRadius=i.styles.borderTopLeftRadius=i.styles.borderBottomRightRadius=i.styles.borderBottomLeftRadius=fo;break;case mo:i.styles.borderTopRightRadius=i.styles.borderTopLeftRadius=i.styles.borderBottomRightRadius=i.styles.borderBottomLeftRadius=ho}return i}return t(r,e),r}(Yn),wo=function(e){function r(t){var r=e.call(this,t)||this,n=t.options[t.selectedIndex||0];return r.value=n&&n.text||"",r}return t(r,e),r}(Yn),bo=function(e){function r(t){var r=e.call(this,t)||this;return r.value=t.value,r}return t(r,e),r}(Yn),Bo=function(e){return ft(Ke.create(e).parseComponentValue())},jo=function(e){function r(t){var r=e.call(this,t)||this;r.src=t.src,r.width=parseInt(t.width,10)||0,r.height=parseInt(t.height,10)||0,r.backgroundColor=r.styles.backgroundColor;try{if(t.contentWindow&&t.contentWindow.document&&t.contentWindow.document.documentElement){r.tree=Eo(t.contentWindow.document.documentElement);var n=t.contentWindow.document.documentElement?Bo(getComputedStyle(t.contentWindow.document.documentElement).backgroundColor):_t.TRANSPARENT,o=t.contentWindow.document.body?Bo(getComputedStyle(t.contentWindow.document.body).backgroundColor):_t.TRANSPARENT;r.backgroundColor=ht(n)?ht(o)?r.styles.backgroundColor:o:n}}catch(e){}return r}return t(r,e),r}(Yn),_o=["OL","UL","MENU"],Co=function(e,t,r){for(var n=e.firstChild,o=void 0;n;n=o)if(o=n.nextSibling,Fo(n)&&n.data.trim().length>0)t.textNodes.push(new no(n,t.styles));else if(Uo(n)){var s=xo(n);s.styles.isVisible()&&(No(n,s,r)?s.flags|=4:Qo(s.styles)&&(s.flags|=2),-1!==_o.indexOf(n.tagName)&&(s.flags|=8),t.elements.push(s),zo(n)||Po(n)||Vo(n)||Co(n,s,r))}},xo=function(e){return Ro(e)?new ao(e):ko(e)?new Ao(e):Po(e)?new uo(e):To(e)?new co(e):Ho(e)?new lo(e):Io(e)?new vo(e):Vo(e)?new wo(e):zo(e)?new bo(e):Mo(e)?new jo(e):new Yn(e)},Eo=function(e){var t=xo(e);return t.flags|=4,Co(e,t,t),t},No=function(e,t,r){return t.styles.isPositionedWithZIndex()||t.styles.opacity<1||t.styles.isTransformed()||Oo(e)&&r.styles.isTransparent()},Qo=function(e){return e.isPositioned()||e.isFloating()},Fo=function(e){return e.nodeType===Node.TEXT_NODE},Uo=function(e){return e.nodeType===Node.ELEMENT_NODE},So=function(e){return Uo(e)&&void 0!==e.style&&!Lo(e)},Lo=function(e){return"object"==typeof e.className},To=function(e){return"LI"===e.tagName},Ho=function(e){return"OL"===e.tagName},Io=function(e){return"INPUT"===e.tagName},Po=function(e){return"svg"===e.tagName},Oo=function(e){return"BODY"===e.tagName},ko=function(e){return"CANVAS"===e.tagName},Ro=function(e){return"IMG"===e.tagName},Mo=function(e){return"IFRAME"===e.tagName},Do=function(e){return"STYLE"===e.tagName},Ko=function(e){return"SCRIPT"===e.tagName},zo=function(e){return"TEXTAREA"===e.tagName},Vo=function(e){return"SELECT"===e.tagName},qo=function(){function e(){this.counters={}}return e.prototype.getCounterValue=function(e){var t=this.counters[e];return t&&t.length?t[t.length-1]:1},e.prototype.getCounterValues=function(e){return this.counters[e]||[]},e.prototype.pop=function(e){var t=this;e.forEach((function(e){return t.counters[e].pop()}))},e.prototype.parse=function(e){var t=this,r=e.counterIncrement,n=e.counterReset,o=!0;null!==r&&r.forEach((function(e){var r=t.counters[e.counter];r&&0!==e.increment&&(o=!1,r[Math.max(0,r.length-1)]+=e.increment)}));var s=[];return o&&n.forEach((function(e){var r=t.counters[e.counter];s.push(e.counter),r||(r=t.counters[e.counter]=[]),r.push(e.reset)})),s},e}(),Go={integers:[1e3,900,500,400,100,90,50,40,10,9,5,4,1],values:["M","CM","D","CD","C","XC","L","XL","X","IX","V","IV","I"]},Xo={integers:[9e3,8e3,7e3,6e3,5e3,4e3,3e3,2e3,1e3,900,800,700,600,500,400,300,200,100,90,80,70,60,50,40,30,20,10,9,8,7,6,5,4,3,2,1],values:["Ք","Փ","Ւ","Ց","Ր","Տ","Վ","Ս","Ռ","Ջ","Պ","Չ","Ո","Շ","Ն","Յ","Մ","Ճ","Ղ","Ձ","Հ","Կ","Ծ","Խ","Լ","Ի","Ժ","Թ","Ը","Է","Զ","Ե","Դ","Գ","Բ","Ա"]},Wo={integers:[1e4,9e3,8e3,7e3,6e3,5e3,4e3,3e3,2e3,1e3,400,300,200,100,90,80,70,60,50,40,30,20,19,18,17,16,15,10,9,8,7,6,5,4,3,2,1],values:["י׳","ט׳","ח׳","ז׳","ו׳","ה׳","ד׳","ג׳","ב׳","א׳","ת","ש","ר","ק","צ","פ","ע","ס","נ","מ","ל","כ","יט","יח","יז","טז","טו","י","ט","ח","ז","ו","ה","ד","ג","ב","א"]},Jo={integers:[1e4,9e3,8e3,7e3,6e3,5e3,4e3,3e3,2e3,1e3,900,800,700,600,500,400,300,200,100,90,80,70,60,50,40,30,20,10,9,8,7,6,5,4,3,2,1],values:["ჵ","ჰ","ჯ","ჴ","ხ","ჭ","წ","ძ","ც","ჩ","შ","ყ","ღ","ქ","ფ","ჳ","ტ","ს","რ","ჟ","პ","ო","ჲ","ნ","მ","ლ","კ","ი","თ","ჱ","ზ","ვ","ე","დ","გ","ბ","ა"]},Yo=function(e,t,r,n,o,s){return e<t||e>r?is(e,o,s.length>0):n.integers.reduce((function(t,r,o){for(;e>=r;)e-=r,t+=n.values[o];return t}),"")+s},Zo=function(e,t,r,n){var o="";do{r||e--,o=n(e)+o,e/=t}while(e*t>=t);return o},$o=function(e,t,r,n,o){var s=r-t+1;return(e<0?"-":"")+(Zo(Math.abs(e),s,n,(function(e){return A(Math.floor(e%s)+t)}))+o)},es=function(e,t,r){void 0===r&&(r=". ");var n=t.length;return Zo(Math.abs(e),n,!1,(function(e){return t[Math.floor(e%n)]}))+r},ts=function(e,t,r,n,o,s){if(e<-9999||e>9999)return is(e,Wr.CJK_DECIMAL,o.length>0);var i=Math.abs(e),a=o;if(0===i)return t[0]+a;for(var A=0;i>0&&A<=4;A++){var u=i%10;0===u&&Rn(s,1)&&""!==a?a=t[u]+a:u>1||1===u&&0===A||1===u&&1===A&&Rn(s,2)||1===u&&1===A&&Rn(s,4)&&e>100||1===u&&A>1&&Rn(s,8)?a=t[u]+(A>0?r[A-1]:"")+a:1===u&&A>0&&(a=r[A-1]+a),i=Math.floor(i/10)}return(e<0?n:"")+a},rs="十百千萬",ns="拾佰仟萬",os="マイナス",ss="마이너스",is=function(e,t,r){var n=r?". ":"",o=r?"、":"",s=r?", ":"",i=r?" ":"";switch(t){case Wr.DISC:return"•"+i;case Wr.CIRCLE:return"◦"+i;case Wr.SQUARE:return"◾"+i;case Wr.DECIMAL_LEADING_ZERO:var a=$o(e,48,57,!0,n);return a.length<4?"0"+a:a;case Wr.CJK_DECIMAL:return es(e,"〇一二三四五六七八九",o);case Wr.LOWER_ROMAN:return Yo(e,1,3999,Go,Wr.DECIMAL,n).toLowerCase();case Wr.UPPER_ROMAN:return Yo(e,1,3999,Go,Wr.DECIMAL,n);case Wr.LOWER_GREEK:return $o(e,945,969,!1,n);case Wr.LOWER_ALPHA:return $o(e,97,122,!1,n);case Wr.UPPER_ALPHA:return $o(e,65,90,!1,n);case Wr.ARABIC_INDIC:return $o(e,1632,1641,!0,n);case Wr.ARMENIAN:case Wr.UPPER_ARMENIAN:return Yo(e,1,9999,Xo,Wr.DECIMAL,n);case Wr.LOWER_ARMENIAN:return Yo(e,1,9999,Xo,Wr.DECIMAL,n).toLowerCase();case Wr.BENGALI:return $o(e,2534,2543,!0,n);case Wr.CAMBODIAN:case Wr.KHMER:return $o(e,6112,6121,!0,n);case Wr.CJK_EARTHLY_BRANCH:return es(e,"子丑寅卯辰巳午未申酉戌亥",o);case Wr.CJK_HEAVENLY_STEM:return es(e,"甲乙丙丁戊己庚辛壬癸",o);case Wr.CJK_IDEOGRAPHIC:case Wr.TRAD_CHINESE_INFORMAL:return ts(e,"零一二三四五六七八九",rs,"負",o,14);case Wr.TRAD_CHINESE_FORMAL:return ts(e,"零壹貳參肆伍陸柒捌玖",ns,"負",o,15);case Wr.SIMP_CHINESE_INFORMAL:return ts(e,"零一二三四五六七八九",rs,"负",o,14);case Wr.SIMP_CHINESE_FORMAL:return ts(e,"零壹贰叁肆伍陆柒捌玖",ns,"负",o,15);case Wr.JAPANESE_INFORMAL:return ts(e,"〇一二三四五六七八九","十百千万",os,o,0);case Wr.JAPANESE_FORMAL:return ts(e,"零壱弐参四伍六七八九","拾百千万",os,o,7);case Wr.KOREAN_HANGUL_FORMAL:return ts(e,"영일이삼사오육칠팔구","십백천만",ss,s,7);case Wr.KOREAN_HANJA_INFORMAL:return ts(e,"零一二三四五六七八九","十百千萬",ss,s,0);case Wr.KOREAN_HANJA_FORMAL:return ts(e,"零壹貳參四五六七八九","拾百千",ss,s,7);case Wr.DEVANAGARI:return $o(e,2406,2415,!0,n);case Wr.GEORGIAN:return Yo(e,1,19999,Jo,Wr.DECIMAL,n);case Wr.GUJARATI:return $o(e,2790,2799,!0,n);case Wr.GURMUKHI:return $o(e,2662,2671,!0,n);case Wr.HEBREW:return Yo(e,1,10999,Wo,Wr.DECIMAL,n);case Wr.HIRAGANA:return es(e,"あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわゐゑをん");case Wr.HIRAGANA_IROHA:return es(e,"いろはにほへとちりぬるをわかよたれそつねならむうゐのおくやまけふこえてあさきゆめみしゑひもせす");case Wr.KANNADA:return $o(e,3302,3311,!0,n);case Wr.KATAKANA:return es(e,"アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワヰヱヲン",o);case Wr.KATAKANA_IROHA:return es(e,"イロハニホヘトチリヌルヲワカヨタレソツネナラムウヰノオクヤマケフコエテアサキユメミシヱヒモセス",o);case Wr.LAO:return $o(e,3792,3801,!0,n);case Wr.MONGOLIAN:return $o(e,6160,6169,!0,n);case Wr.MYANMAR:return $o(e,4160,4169,!0,n);case Wr.ORIYA:return $o(e,2918,2927,!0,n);case Wr.PERSIAN:return $o(e,1776,1785,!0,n);case Wr.TAMIL:return $o(e,3046,3055,!0,n);case Wr.TELUGU:return $o(e,3174,3183,!0,n);case Wr.THAI:return $o(e,3664,3673,!0,n);case Wr.TIBETAN:return $o(e,3872,3881,!0,n);case Wr.DECIMAL:default:return $o(e,48,57,!0,n)}},as="data-html2canvas-ignore",As=function(){function e(e,t){if(this.options=t,this.scrolledElements=[],this.referenceElement=e,this.counters=new qo,this.quoteDepth=0,!e.ownerDocument)throw new Error("Cloned element does not have an owner document");this.documentElement=this.cloneNode(e.ownerDocument.documentElement)}return e.prototype.toIFrame=function(e,t){var r=this,s=cs(e,t);if(!s.contentWindow)return Promise.reject("Unable to find iframe window");var i=e.defaultView.pageXOffset,a=e.defaultView.pageYOffset,A=s.contentWindow,u=A.document,c=ls(s).then((function(){return n(r,void 0,void 0,(function(){var e;return o(this,(function(r){switch(r.label){case 0:return this.scrolledElements.forEach(ps),A&&(A.scrollTo(t.left,t.top),!/(iPad|iPhone|iPod)/g.test(navigator.userAgent)||A.scrollY===t.top&&A.scrollX===t.left||(u.documentElement.style.top=-t.top+"px",u.documentElement.style.left=-t.left+"px",u.documentElement.style.position="absolute")),e=this.options.onclone,void 0===this.clonedReferenceElement?[2,Promise.reject("Error finding the "+this.referenceElement.nodeName+" in the cloned document")]:u.fonts&&u.fonts.ready?[4,u.fonts.ready]:[3,2];case 1:r.sent(),r.label=2;case 2:return"function"==typeof e?[2,Promise.resolve().then((function(){return e(u)})).then((function(){return s}))]:[2,s]}}))}))}));return u.open(),u.write(fs(document.doctype)+"<html></html>"),hs(this.referenceElement.ownerDocument,i,a),u.replaceChild(u.adoptNode(this.documentElement),u.documentElement),u.close(),c},e.prototype.createElementClone=function(e){if(ko(e))return this.createCanvasClone(e);if(Do(e))return this.createStyleClone(e);var t=e.cloneNode(!1);return Ro(t)&&"lazy"===t.loading&&(t.loading="eager"),t},e.prototype.createStyleClone=function(e){try{var t=e.sheet;if(t&&t.cssRules){var r=[].slice.call(t.cssRules,0).reduce((function(e,t){return t&&"string"==typeof t.cssText?e+t.cssText:e}),""),n=e.cloneNode(!1);return n.textContent=r,n}}catch(e){if(Ot.getInstance(this.options.id).error("Unable to access cssRules property",e),"SecurityError"!==e.name)throw e}return e.cloneNode(!1)},e.prototype.createCanvasClone=function(e){if(this.options.inlineImages&&e.ownerDocument){var t=e.ownerDocument.createElement("img");try{return t.src=e.toDataURL(),t}catch(e){Ot.getInstance(this.options.id).info("Unable to clone canvas contents, canvas is tainted")}}var r=e.cloneNode(!1);try{r.width=e.width,r.height=e.height;var n=e.getContext("2d"),o=r.getContext("2d");return o&&(n?o.putImageData(n.getImageData(0,0,e.width,e.height),0,0):o.drawImage(e,0,0)),r}catch(e){}return r},e.prototype.cloneNode=function(e){if(Fo(e))return document.createTextNode(e.data);if(!e.ownerDocument)return e.cloneNode(!1);var t=e.ownerDocument.defaultView;if(t&&Uo(e)&&(So(e)||Lo(e))){var r=this.createElementClone(e),n=t.getComputedStyle(e),o=t.getComputedStyle(e,":before"),s=t.getComputedStyle(e,":after");this.referenceElement===e&&So(r)&&(this.clonedReferenceElement=r),Oo(r)&&vs(r);for(var i=this.counters.parse(new Wn(n)),a=this.resolvePseudoContent(e,r,o,On.BEFORE),A=e.firstChild;A;A=A.nextSibling)Uo(A)&&(Ko(A)||A.hasAttribute(as)||"function"==typeof this.options.ignoreElements&&this.options.ignoreElements(A))||this.options.copyStyles&&Uo(A)&&Do(A)||r.appendChild(this.cloneNode(A));a&&r.insertBefore(a,r.firstChild);var u=this.resolvePseudoContent(e,r,s,On.AFTER);return u&&r.appendChild(u),this.counters.pop(i),n&&(this.options.copyStyles||Lo(e))&&!Mo(e)&&ds(n,r),0===e.scrollTop&&0===e.scrollLeft||this.scrolledElements.push([r,e.scrollLeft,e.scrollTop]),(zo(e)||Vo(e))&&(zo(r)||Vo(r))&&(r.value=e.value),r}return e.cloneNode(!1)},e.prototype.resolvePseudoContent=function(e,t,r,n){var o=this;if(r){var s=r.content,i=t.ownerDocument;if(i&&s&&"none"!==s&&"-moz-alt-content"!==s&&"none"!==r.display){this.counters.parse(new Wn(r));var a=new Xn(r),A=i.createElement("html2canvaspseudoelement");ds(r,A),a.content.forEach((function(t){if(t.type===d.STRING_TOKEN)A.appendChild(i.createTextNode(t.value));else if(t.type===d.URL_TOKEN){var r=i.createElement("img");r.src=t.value,r.style.opacity="1",A.appendChild(r)}else if(t.type===d.FUNCTION){if("attr"===t.name){var n=t.values.filter(qe);n.length&&A.appendChild(i.createTextNode(e.getAttribute(n[0].value)||""))}else if("counter"===t.name){var s=t.values.filter(Je),u=s[0],c=s[1];if(u&&qe(u)){var l=o.counters.getCounterValue(u.value),f=c&&qe(c)?Zr.parse(c.value):Wr.DECIMAL;A.appendChild(i.createTextNode(is(l,f,!1)))}}else if("counters"===t.name){var h=t.values.filter(Je),p=(u=h[0],h[1]);if(c=h[2],u&&qe(u)){var m=o.counters.getCounterValues(u.value),g=c&&qe(c)?Zr.parse(c.value):Wr.DECIMAL,y=p&&p.type===d.STRING_TOKEN?p.value:"",v=m.map((function(e){return is(e,g,!1)})).join(y);A.appendChild(i.createTextNode(v))}}}else if(t.type===d.IDENT_TOKEN)switch(t.value){case"open-quote":A.appendChild(i.createTextNode(Vn(a.quotes,o.quoteDepth++,!0)));break;case"close-quote":A.appendChild(i.createTextNode(Vn(a.quotes,--o.quoteDepth,!1)));break;default:A.appendChild(i.createTextNode(t.value))}})),A.className=ms+" "+gs;var u=n===On.BEFORE?" "+ms:" "+gs;return Lo(t)?t.className.baseValue+=u:t.className+=u,A}}},e.destroy=function(e){return!!e.parentNode&&(e.parentNode.removeChild(e),!0)},e}();!function(e){e[e.BEFORE=0]="BEFORE",e[e.AFTER=1]="AFTER"}(On||(On={}));var us,cs=function(e,t){var r=e.createElement("iframe");return r.className="html2canvas-container",r.style.visibility="hidden",r.style.position="fixed",r.style.left="-10000px",r.style.top="0px",r.style.border="0",r.width=t.width.toString(),r.height=t.height.toString(),r.scrolling="no",r.setAttribute(as,"true"),e.body.appendChild(r),r},ls=function(e){return new Promise((function(t,r){var n=e.contentWindow;if(!n)return r("No window assigned for iframe");var o=n.document;n.onload=e.onload=o.onreadystatechange=function(){n.onload=e.onload=o.onreadystatechange=null;var r=setInterval((function(){o.body.childNodes.length>0&&"complete"===o.readyState&&(clearInterval(r),t(e))}),50)}}))},ds=function(e,t){for(var r=e.length-1;r>=0;r--){var n=e.item(r);"content"!==n&&t.style.setProperty(n,e.getPropertyValue(n))}return t},fs=function(e){var t="";return e&&(t+="<!DOCTYPE ",e.name&&(t+=e.name),e.internalSubset&&(t+=e.internalSubset),e.publicId&&(t+='"'+e.publicId+'"'),e.systemId&&(t+='"'+e.systemId+'"'),t+=">"),t},hs=function(e,t,r){e&&e.defaultView&&(t!==e.defaultView.pageXOffset||r!==e.defaultView.pageYOffset)&&e.defaultView.scrollTo(t,r)},ps=function(e){var t=e[0],r=e[1],n=e[2];t.scrollLeft=r,t.scrollTop=n},ms="___html2canvas___pseudoelement_before",gs="___html2canvas___pseudoelement_after",ys='{\n    content: "" !important;\n    display: none !important;\n}',vs=function(e){ws(e,"."+ms+":before"+ys+"\n         ."+gs+":after"+ys)},ws=function(e,t){var r=e.ownerDocument;if(r){var n=r.createElement("style");n.textContent=t,e.appendChild(n)}};!function(e){e[e.VECTOR=0]="VECTOR",e[e.BEZIER_CURVE=1]="BEZIER_CURVE"}(us||(us={}));var bs,Bs=function(e,t){return e.length===t.length&&e.some((function(e,r){return e===t[r]}))},js=function(){function e(e,t){this.type=us.VECTOR,this.x=e,this.y=t}return e.prototype.add=function(t,r){return new e(this.x+t,this.y+r)},e}(),_s=function(e,t,r){return new js(e.x+(t.x-e.x)*r,e.y+(t.y-e.y)*r)},Cs=function(){function e(e,t,r,n){this.type=us.BEZIER_CURVE,this.start=e,this.startControl=t,this.endControl=r,this.end=n}return e.prototype.subdivide=function(t,r){var n=_s(this.start,this.startControl,t),o=_s(this.startControl,this.endControl,t),s=_s(this.endControl,this.end,t),i=_s(n,o,t),a=_s(o,s,t),A=_s(i,a,t);return r?new e(this.start,n,i,A):new e(A,a,s,this.end)},e.prototype.add=function(t,r){return new e(this.start.add(t,r),this.startControl.add(t,r),this.endControl.add(t,r),this.end.add(t,r))},e.prototype.reverse=function(){return new e(this.end,this.endControl,this.startControl,this.start)},e}(),xs=function(e){return e.type===us.BEZIER_CURVE},Es=function(e){var t=e.styles,r=e.bounds,n=st(t.borderTopLeftRadius,r.width,r.height),o=n[0],s=n[1],i=st(t.borderTopRightRadius,r.width,r.height),a=i[0],A=i[1],u=st(t.borderBottomRightRadius,r.width,r.height),c=u[0],l=u[1],d=st(t.borderBottomLeftRadius,r.width,r.height),f=d[0],h=d[1],p=[];p.push((o+a)/r.width),p.push((f+c)/r.width),p.push((s+h)/r.height),p.push((A+l)/r.height);var m=Math.max.apply(Math,p);m>1&&(o/=m,s/=m,a/=m,A/=m,c/=m,l/=m,f/=m,h/=m);var g=r.width-a,y=r.height-l,v=r.width-c,w=r.height-h,b=t.borderTopWidth,B=t.borderRightWidth,j=t.borderBottomWidth,_=t.borderLeftWidth,C=it(t.paddingTop,e.bounds.width),x=it(t.paddingRight,e.bounds.width),E=it(t.paddingBottom,e.bounds.width),N=it(t.paddingLeft,e.bounds.width);this.topLeftBorderDoubleOuterBox=o>0||s>0?Ns(r.left+_/3,r.top+b/3,o-_/3,s-b/3,bs.TOP_LEFT):new js(r.left+_/3,r.top+b/3),this.topRightBorderDoubleOuterBox=o>0||s>0?Ns(r.left+g,r.top+b/3,a-B/3,A-b/3,bs.TOP_RIGHT):new js(r.left+r.width-B/3,r.top+b/3),this.bottomRightBorderDoubleOuterBox=c>0||l>0?Ns(r.left+v,r.top+y,c-B/3,l-j/3,bs.BOTTOM_RIGHT):new js(r.left+r.width-B/3,r.top+r.height-j/3),this.bottomLeftBorderDoubleOuterBox=f>0||h>0?Ns(r.left+_/3,r.top+w,f-_/3,h-j/3,bs.BOTTOM_LEFT):new js(r.left+_/3,r.top+r.height-j/3),this.topLeftBorderDoubleInnerBox=o>0||s>0?Ns(r.left+2*_/3,r.top+2*b/3,o-2*_/3,s-2*b/3,bs.TOP_LEFT):new js(r.left+2*_/3,r.top+2*b/3),this.topRightBorderDoubleInnerBox=o>0||s>0?Ns(r.left+g,r.top+2*b/3,a-2*B/3,A-2*b/3,bs.TOP_RIGHT):new js(r.left+r.width-2*B/3,r.top+2*b/3),this.bottomRightBorderDoubleInnerBox=c>0||l>0?Ns(r.left+v,r.top+y,c-2*B/3,l-2*j/3,bs.BOTTOM_RIGHT):new js(r.left+r.width-2*B/3,r.top+r.height-2*j/3),this.bottomLeftBorderDoubleInnerBox=f>0||h>0?Ns(r.left+2*_/3,r.top+w,f-2*_/3,h-2*j/3,bs.BOTTOM_LEFT):new js(r.left+2*_/3,r.top+r.height-2*j/3),this.topLeftBorderStroke=o>0||s>0?Ns(r.left+_/2,r.top+b/2,o-_/2,s-b/2,bs.TOP_LEFT):new js(r.left+_/2,r.top+b/2),this.topRightBorderStroke=o>0||s>0?Ns(r.left+g,r.top+b/2,a-B/2,A-b/2,bs.TOP_RIGHT):new js(r.left+r.width-B/2,r.top+b/2),this.bottomRightBorderStroke=c>0||l>0?Ns(r.left+v,r.top+y,c-B/2,l-j/2,bs.BOTTOM_RIGHT):new js(r.left+r.width-B/2,r.top+r.height-j/2),this.bottomLeftBorderStroke=f>0||h>0?Ns(r.left+_/2,r.top+w,f-_/2,h-j/2,bs.BOTTOM_LEFT):new js(r.left+_/2,r.top+r.height-j/2),this.topLeftBorderBox=o>0||s>0?Ns(r.left,r.top,o,s,bs.TOP_LEFT):new js(r.left,r.top),this.topRightBorderBox=a>0||A>0?Ns(r.left+g,r.top,a,A,bs.TOP_RIGHT):new js(r.left+r.width,r.top),this.bottomRightBorderBox=c>0||l>0?Ns(r.left+v,r.top+y,c,l,bs.BOTTOM_RIGHT):new js(r.left+r.width,r.top+r.height),this.bottomLeftBorderBox=f>0||h>0?Ns(r.left,r.top+w,f,h,bs.BOTTOM_LEFT):new js(r.left,r.top+r.height),this.topLeftPaddingBox=o>0||s>0?Ns(r.left+_,r.top+b,Math.max(0,o-_),Math.max(0,s-b),bs.TOP_LEFT):new js(r.left+_,r.top+b),this.topRightPaddingBox=a>0||A>0?Ns(r.left+Math.min(g,r.width-B),r.top+b,g>r.width+B?0:Math.max(0,a-B),Math.max(0,A-b),bs.TOP_RIGHT):new js(r.left+r.width-B,r.top+b),this.bottomRightPaddingBox=c>0||l>0?Ns(r.left+Math.min(v,r.width-_),r.top+Math.min(y,r.height-j),Math.max(0,c-B),Math.max(0,l-j),bs.BOTTOM_RIGHT):new js(r.left+r.width-B,r.top+r.height-j),this.bottomLeftPaddingBox=f>0||h>0?Ns(r.left+_,r.top+Math.min(w,r.height-j),Math.max(0,f-_),Math.max(0,h-j),bs.BOTTOM_LEFT):new js(r.left+_,r.top+r.height-j),this.topLeftContentBox=o>0||s>0?Ns(r.left+_+N,r.top+b+C,Math.max(0,o-(_+N)),Math.max(0,s-(b+C)),bs.TOP_LEFT):new js(r.left+_+N,r.top+b+C),this.topRightContentBox=a>0||A>0?Ns(r.left+Math.min(g,r.width+_+N),r.top+b+C,g>r.width+_+N?0:a-_+N,A-(b+C),bs.TOP_RIGHT):new js(r.left+r.width-(B+x),r.top+b+C),this.bottomRightContentBox=c>0||l>0?Ns(r.left+Math.min(v,r.width-(_+N)),r.top+Math.min(y,r.height+b+C),Math.max(0,c-(B+x)),l-(j+E),bs.BOTTOM_RIGHT):new js(r.left+r.width-(B+x),r.top+r.height-(j+E)),this.bottomLeftContentBox=f>0||h>0?Ns(r.left+_+N,r.top+w,Math.max(0,f-(_+N)),h-(j+E),bs.BOTTOM_LEFT):new js(r.left+_+N,r.top+r.height-(j+E))};!function(e){e[e.TOP_LEFT=0]="TOP_LEFT",e[e.TOP_RIGHT=1]="TOP_RIGHT",e[e.BOTTOM_RIGHT=2]="BOTTOM_RIGHT",e[e.BOTTOM_LEFT=3]="BOTTOM_LEFT"}(bs||(bs={}));var Ns=function(e,t,r,n,o){var s=(Math.sqrt(2)-1)/3*4,i=r*s,a=n*s,A=e+r,u=t+n;switch(o){case bs.TOP_LEFT:return new Cs(new js(e,u),new js(e,u-a),new js(A-i,t),new js(A,t));case bs.TOP_RIGHT:return new Cs(new js(e,t),new js(e+i,t),new js(A,u-a),new js(A,u));case bs.BOTTOM_RIGHT:return new Cs(new js(A,t),new js(A,t+a),new js(e+i,u),new js(e,u));case bs.BOTTOM_LEFT:default:return new Cs(new js(A,u),new js(A-i,u),new js(e,t+a),new js(e,t))}},Qs=function(e){return[e.topLeftBorderBox,e.topRightBorderBox,e.bottomRightBorderBox,e.bottomLeftBorderBox]},Fs=function(e){return[e.topLeftPaddingBox,e.topRightPaddingBox,e.bottomRightPaddingBox,e.bottomLeftPaddingBox]},Us=function(e,t,r){this.type=0,this.target=6,this.offsetX=e,this.offsetY=t,this.matrix=r},Ss=function(e,t){this.type=1,this.target=t,this.path=e},Ls=function(e){this.type=2,this.target=6,this.opacity=e},Ts=function(e){this.element=e,this.inlineLevel=[],this.nonInlineLevel=[],this.negativeZIndex=[],this.zeroOrAutoZIndexOrTransformedOrOpacity=[],this.positiveZIndex=[],this.nonPositionedFloats=[],this.nonPositionedInlineLevel=[]},Hs=function(){function e(e,t){if(this.container=e,this.effects=t.slice(0),this.curves=new Es(e),e.styles.opacity<1&&this.effects.push(new Ls(e.styles.opacity)),null!==e.styles.transform){var r=e.bounds.left+e.styles.transformOrigin[0].number,n=e.bounds.top+e.styles.transformOrigin[1].number,o=e.styles.transform;this.effects.push(new Us(r,n,o))}if(e.styles.overflowX!==Yr.VISIBLE){var s=Qs(this.curves),i=Fs(this.curves);Bs(s,i)?this.effects.push(new Ss(s,6)):(this.effects.push(new Ss(s,2)),this.effects.push(new Ss(i,4)))}}return e.prototype.getParentEffects=function(){var e=this.effects.slice(0);if(this.container.styles.overflowX!==Yr.VISIBLE){var t=Qs(this.curves),r=Fs(this.curves);Bs(t,r)||e.push(new Ss(r,6))}return e},e}(),Is=function(e,t,r,n){e.container.elements.forEach((function(o){var s=Rn(o.flags,4),i=Rn(o.flags,2),a=new Hs(o,e.getParentEffects());Rn(o.styles.display,2048)&&n.push(a);var A=Rn(o.flags,8)?[]:n;if(s||i){var u=s||o.styles.isPositioned()?r:t,c=new Ts(a);if(o.styles.isPositioned()||o.styles.opacity<1||o.styles.isTransformed()){var l=o.styles.zIndex.order;if(l<0){var d=0;u.negativeZIndex.some((function(e,t){return l>e.element.container.styles.zIndex.order?(d=t,!1):d>0})),u.negativeZIndex.splice(d,0,c)}else if(l>0){var f=0;u.positiveZIndex.some((function(e,t){return l>=e.element.container.styles.zIndex.order?(f=t+1,!1):f>0})),u.positiveZIndex.splice(f,0,c)}else u.zeroOrAutoZIndexOrTransformedOrOpacity.push(c)}else o.styles.isFloating()?u.nonPositionedFloats.push(c):u.nonPositionedInlineLevel.push(c);Is(a,c,s?c:r,A)}else o.styles.isInlineLevel()?t.inlineLevel.push(a):t.nonInlineLevel.push(a),Is(a,t,r,A);Rn(o.flags,8)&&Ps(o,A)}))},Ps=function(e,t){for(var r=e instanceof lo?e.start:1,n=e instanceof lo&&e.reversed,o=0;o<t.length;o++){var s=t[o];s.container instanceof co&&"number"==typeof s.container.value&&0!==s.container.value&&(r=s.container.value),s.listValue=is(r,s.container.styles.listStyleType,!0),r+=n?-1:1}},Os=function(e,t){switch(t){case 0:return Rs(e.topLeftBorderBox,e.topLeftPaddingBox,e.topRightBorderBox,e.topRightPaddingBox);case 1:return Rs(e.topRightBorderBox,e.topRightPaddingBox,e.bottomRightBorderBox,e.bottomRightPaddingBox);case 2:return Rs(e.bottomRightBorderBox,e.bottomRightPaddingBox,e.bottomLeftBorderBox,e.bottomLeftPaddingBox);case 3:default:return Rs(e.bottomLeftBorderBox,e.bottomLeftPaddingBox,e.topLeftBorderBox,e.topLeftPaddingBox)}},ks=function(e,t){var r=[];return xs(e)?r.push(e.subdivide(.5,!1)):r.push(e),xs(t)?r.push(t.subdivide(.5,!0)):r.push(t),r},Rs=function(e,t,r,n){var o=[];return xs(e)?o.push(e.subdivide(.5,!1)):o.push(e),xs(r)?o.push(r.subdivide(.5,!0)):o.push(r),xs(n)?o.push(n.subdivide(.5,!0).reverse()):o.push(n),xs(t)?o.push(t.subdivide(.5,!1).reverse()):o.push(t),o},Ms=function(e){var t=e.bounds,r=e.styles;return t.add(r.borderLeftWidth,r.borderTopWidth,-(r.borderRightWidth+r.borderLeftWidth),-(r.borderTopWidth+r.borderBottomWidth))},Ds=function(e){var t=e.styles,r=e.bounds,n=it(t.paddingLeft,r.width),o=it(t.paddingRight,r.width),s=it(t.paddingTop,r.width),i=it(t.paddingBottom,r.width);return r.add(n+t.borderLeftWidth,s+t.borderTopWidth,-(t.borderRightWidth+t.borderLeftWidth+n+o),-(t.borderTopWidth+t.borderBottomWidth+s+i))},Ks=function(e,t,r){var n=function(e,t){return 0===e?t.bounds:2===e?Ds(t):Ms(t)}(Gs(e.styles.backgroundOrigin,t),e),o=function(e,t){return e===bt.BORDER_BOX?t.bounds:e===bt.CONTENT_BOX?Ds(t):Ms(t)}(Gs(e.styles.backgroundClip,t),e),s=qs(Gs(e.styles.backgroundSize,t),r,n),i=s[0],a=s[1],A=st(Gs(e.styles.backgroundPosition,t),n.width-i,n.height-a);return[Xs(Gs(e.styles.backgroundRepeat,t),A,s,n,o),Math.round(n.left+A[0]),Math.round(n.top+A[1]),i,a]},zs=function(e){return qe(e)&&e.value===dr.AUTO},Vs=function(e){return"number"==typeof e},qs=function(e,t,r){var n=t[0],o=t[1],s=t[2],i=e[0],a=e[1];if(et(i)&&a&&et(a))return[it(i,r.width),it(a,r.height)];var A=Vs(s);if(qe(i)&&(i.value===dr.CONTAIN||i.value===dr.COVER))return Vs(s)?r.width/r.height<s!=(i.value===dr.COVER)?[r.width,r.width/s]:[r.height*s,r.height]:[r.width,r.height];var u=Vs(n),c=Vs(o),l=u||c;if(zs(i)&&(!a||zs(a)))return u&&c?[n,o]:A||l?l&&A?[u?n:o*s,c?o:n/s]:[u?n:r.width,c?o:r.height]:[r.width,r.height];if(A){var d=0,f=0;return et(i)?d=it(i,r.width):et(a)&&(f=it(a,r.height)),zs(i)?d=f*s:a&&!zs(a)||(f=d/s),[d,f]}var h=null,p=null;if(et(i)?h=it(i,r.width):a&&et(a)&&(p=it(a,r.height)),null===h||a&&!zs(a)||(p=u&&c?h/n*o:r.height),null!==p&&zs(i)&&(h=u&&c?p/o*n:r.width),null!==h&&null!==p)return[h,p];throw new Error("Unable to calculate background-size for element")},Gs=function(e,t){var r=e[t];return void 0===r?e[0]:r},Xs=function(e,t,r,n,o){var s=t[0],i=t[1],a=r[0],A=r[1];switch(e){case ar.REPEAT_X:return[new js(Math.round(n.left),Math.round(n.top+i)),new js(Math.round(n.left+n.width),Math.round(n.top+i)),new js(Math.round(n.left+n.width),Math.round(A+n.top+i)),new js(Math.round(n.left),Math.round(A+n.top+i))];case ar.REPEAT_Y:return[new js(Math.round(n.left+s),Math.round(n.top)),new js(Math.round(n.left+s+a),Math.round(n.top)),new js(Math.round(n.left+s+a),Math.round(n.height+n.top)),new js(Math.round(n.left+s),Math.round(n.height+n.top))];case ar.NO_REPEAT:return[new js(Math.round(n.left+s),Math.round(n.top+i)),new js(Math.round(n.left+s+a),Math.round(n.top+i)),new js(Math.round(n.left+s+a),Math.round(n.top+i+A)),new js(Math.round(n.left+s),Math.round(n.top+i+A))];default:return[new js(Math.round(o.left),Math.round(o.top)),new js(Math.round(o.left+o.width),Math.round(o.top)),new js(Math.round(o.left+o.width),Math.round(o.height+o.top)),new js(Math.round(o.left),Math.round(o.height+o.top))]}},Ws="Hidden Text",Js=function(){function e(e){this._data={},this._document=e}return e.prototype.parseMetrics=function(e,t){var r=this._document.createElement("div"),n=this._document.createElement("img"),o=this._document.createElement("span"),s=this._document.body;r.style.visibility="hidden",r.style.fontFamily=e,r.style.fontSize=t,r.style.margin="0",r.style.padding="0",s.appendChild(r),n.src="data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7",n.width=1,n.height=1,n.style.margin="0",n.style.padding="0",n.style.verticalAlign="baseline",o.style.fontFamily=e,o.style.fontSize=t,o.style.margin="0",o.style.padding="0",o.appendChild(this._document.createTextNode(Ws)),r.appendChild(o),r.appendChild(n);var i=n.offsetTop-o.offsetTop+2;r.removeChild(o),r.appendChild(this._document.createTextNode(Ws)),r.style.lineHeight="normal",n.style.verticalAlign="super";var a=n.offsetTop-r.offsetTop+2;return s.removeChild(r),{baseline:i,middle:a}},e.prototype.getMetrics=function(e,t){var r=e+" "+t;return void 0===this._data[r]&&(this._data[r]=this.parseMetrics(e,t)),this._data[r]},e}(),Ys=function(){function e(e){this._activeEffects=[],this.canvas=e.canvas?e.canvas:document.createElement("canvas"),this.ctx=this.canvas.getContext("2d"),this.options=e,e.canvas||(this.canvas.width=Math.floor(e.width*e.scale),this.canvas.height=Math.floor(e.height*e.scale),this.canvas.style.width=e.width+"px",this.canvas.style.height=e.height+"px"),this.fontMetrics=new Js(document),this.ctx.scale(this.options.scale,this.options.scale),this.ctx.translate(-e.x+e.scrollX,-e.y+e.scrollY),this.ctx.textBaseline="bottom",this._activeEffects=[],Ot.getInstance(e.id).debug("Canvas renderer initialized ("+e.width+"x"+e.height+" at "+e.x+","+e.y+") with scale "+e.scale)}return e.prototype.applyEffects=function(e,t){for(var r=this;this._activeEffects.length;)this.popEffect();e.filter((function(e){return Rn(e.target,t)})).forEach((function(e){return r.applyEffect(e)}))},e.prototype.applyEffect=function(e){this.ctx.save(),function(e){return 2===e.type}(e)&&(this.ctx.globalAlpha=e.opacity),function(e){return 0===e.type}(e)&&(this.ctx.translate(e.offsetX,e.offsetY),this.ctx.transform(e.matrix[0],e.matrix[1],e.matrix[2],e.matrix[3],e.matrix[4],e.matrix[5]),this.ctx.translate(-e.offsetX,-e.offsetY)),function(e){return 1===e.type}(e)&&(this.path(e.path),this.ctx.clip()),this._activeEffects.push(e)},e.prototype.popEffect=function(){this._activeEffects.pop(),this.ctx.restore()},e.prototype.renderStack=function(e){return n(this,void 0,void 0,(function(){return o(this,(function(t){switch(t.label){case 0:return e.element.container.styles.isVisible()?[4,this.renderStackContent(e)]:[3,2];case 1:t.sent(),t.label=2;case 2:return[2]}}))}))},e.prototype.renderNode=function(e){return n(this,void 0,void 0,(function(){return o(this,(function(t){switch(t.label){case 0:return e.container.styles.isVisible()?[4,this.renderNodeBackgroundAndBorders(e)]:[3,3];case 1:return t.sent(),[4,this.renderNodeContent(e)];case 2:t.sent(),t.label=3;case 3:return[2]}}))}))},e.prototype.renderTextWithLetterSpacing=function(e,t){var r=this;0===t?this.ctx.fillText(e.text,e.bounds.left,e.bounds.top+e.bounds.height):a(e.text).map((function(e){return A(e)})).reduce((function(t,n){return r.ctx.fillText(n,t,e.bounds.top+e.bounds.height),t+r.ctx.measureText(n).width}),e.bounds.left)},e.prototype.createFontStyle=function(e){var t=e.fontVariant.filter((function(e){return"normal"===e||"small-caps"===e})).join(""),r=e.fontFamily.join(", "),n=ze(e.fontSize)?""+e.fontSize.number+e.fontSize.unit:e.fontSize.number+"px";return[[e.fontStyle,t,e.fontWeight,n,r].join(" "),r,n]},e.prototype.renderTextNode=function(e,t){return n(this,void 0,void 0,(function(){var r,n,s,i,a=this;return o(this,(function(o){return r=this.createFontStyle(t),n=r[0],s=r[1],i=r[2],this.ctx.font=n,e.textBounds.forEach((function(e){a.ctx.fillStyle=pt(t.color),a.renderTextWithLetterSpacing(e,t.letterSpacing);var r=t.textShadow;r.length&&e.text.trim().length&&(r.slice(0).reverse().forEach((function(t){a.ctx.shadowColor=pt(t.color),a.ctx.shadowOffsetX=t.offsetX.number*a.options.scale,a.ctx.shadowOffsetY=t.offsetY.number*a.options.scale,a.ctx.shadowBlur=t.blur.number,a.ctx.fillText(e.text,e.bounds.left,e.bounds.top+e.bounds.height)})),a.ctx.shadowColor="",a.ctx.shadowOffsetX=0,a.ctx.shadowOffsetY=0,a.ctx.shadowBlur=0),t.textDecorationLine.length&&(a.ctx.fillStyle=pt(t.textDecorationColor||t.color),t.textDecorationLine.forEach((function(t){switch(t){case 1:var r=a.fontMetrics.getMetrics(s,i).baseline;a.ctx.fillRect(e.bounds.left,Math.round(e.bounds.top+r),e.bounds.width,1);break;case 2:a.ctx.fillRect(e.bounds.left,Math.round(e.bounds.top),e.bounds.width,1);break;case 3:var n=a.fontMetrics.getMetrics(s,i).middle;a.ctx.fillRect(e.bounds.left,Math.ceil(e.bounds.top+n),e.bounds.width,1)}})))})),[2]}))}))},e.prototype.renderReplacedElement=function(e,t,r){if(r&&e.intrinsicWidth>0&&e.intrinsicHeight>0){var n=Ds(e),o=Fs(t);this.path(o),this.ctx.save(),this.ctx.clip(),this.ctx.drawImage(r,0,0,e.intrinsicWidth,e.intrinsicHeight,n.left,n.top,n.width,n.height),this.ctx.restore()}},e.prototype.renderNodeContent=function(t){return n(this,void 0,void 0,(function(){var r,n,i,a,A,u,c,l,f,h,p,m,g,y;return o(this,(function(o){switch(o.label){case 0:this.applyEffects(t.effects,4),r=t.container,n=t.curves,i=r.styles,a=0,A=r.textNodes,o.label=1;case 1:return a<A.length?(u=A[a],[4,this.renderTextNode(u,i)]):[3,4];case 2:o.sent(),o.label=3;case 3:return a++,[3,1];case 4:if(!(r instanceof ao))return[3,8];o.label=5;case 5:return o.trys.push([5,7,,8]),[4,this.options.cache.match(r.src)];case 6:return m=o.sent(),this.renderReplacedElement(r,n,m),[3,8];case 7:return o.sent(),Ot.getInstance(this.options.id).error("Error loading image "+r.src),[3,8];case 8:if(r instanceof Ao&&this.renderReplacedElement(r,n,r.canvas),!(r instanceof uo))return[3,12];o.label=9;case 9:return o.trys.push([9,11,,12]),[4,this.options.cache.match(r.svg)];case 10:return m=o.sent(),this.renderReplacedElement(r,n,m),[3,12];case 11:return o.sent(),Ot.getInstance(this.options.id).error("Error loading svg "+r.svg.substring(0,255)),[3,12];case 12:return r instanceof jo&&r.tree?[4,new e({id:this.options.id,scale:this.options.scale,backgroundColor:r.backgroundColor,x:0,y:0,scrollX:0,scrollY:0,width:r.width,height:r.height,cache:this.options.cache,windowWidth:r.width,windowHeight:r.height}).render(r.tree)]:[3,14];case 13:c=o.sent(),r.width&&r.height&&this.ctx.drawImage(c,0,0,r.width,r.height,r.bounds.left,r.bounds.top,r.bounds.width,r.bounds.height),o.label=14;case 14:if(r instanceof vo&&(l=Math.min(r.bounds.width,r.bounds.height),r.type===po?r.checked&&(this.ctx.save(),this.path([new js(r.bounds.left+.39363*l,r.bounds.top+.79*l),new js(r.bounds.left+.16*l,r.bounds.top+.5549*l),new js(r.bounds.left+.27347*l,r.bounds.top+.44071*l),new js(r.bounds.left+.39694*l,r.bounds.top+.5649*l),new js(r.bounds.left+.72983*l,r.bounds.top+.23*l),new js(r.bounds.left+.84*l,r.bounds.top+.34085*l),new js(r.bounds.left+.39363*l,r.bounds.top+.79*l)]),this.ctx.fillStyle=pt(yo),this.ctx.fill(),this.ctx.restore()):r.type===mo&&r.checked&&(this.ctx.save(),this.ctx.beginPath(),this.ctx.arc(r.bounds.left+l/2,r.bounds.top+l/2,l/4,0,2*Math.PI,!0),this.ctx.fillStyle=pt(yo),this.ctx.fill(),this.ctx.restore())),Zs(r)&&r.value.length){switch(this.ctx.font=this.createFontStyle(i)[0],this.ctx.fillStyle=pt(i.color),this.ctx.textBaseline="middle",this.ctx.textAlign=ei(r.styles.textAlign),y=Ds(r),f=0,r.styles.textAlign){case an.CENTER:f+=y.width/2;break;case an.RIGHT:f+=y.width}h=y.add(f,0,0,-y.height/2+1),this.ctx.save(),this.path([new js(y.left,y.top),new js(y.left+y.width,y.top),new js(y.left+y.width,y.top+y.height),new js(y.left,y.top+y.height)]),this.ctx.clip(),this.renderTextWithLetterSpacing(new Zn(r.value,h),i.letterSpacing),this.ctx.restore(),this.ctx.textBaseline="bottom",this.ctx.textAlign="left"}if(!Rn(r.styles.display,2048))return[3,20];if(null===r.styles.listStyleImage)return[3,19];if((p=r.styles.listStyleImage).type!==Ct.URL)return[3,18];m=void 0,g=p.url,o.label=15;case 15:return o.trys.push([15,17,,18]),[4,this.options.cache.match(g)];case 16:return m=o.sent(),this.ctx.drawImage(m,r.bounds.left-(m.width+10),r.bounds.top),[3,18];case 17:return o.sent(),Ot.getInstance(this.options.id).error("Error loading list-style-image "+g),[3,18];case 18:return[3,20];case 19:t.listValue&&r.styles.listStyleType!==Wr.NONE&&(this.ctx.font=this.createFontStyle(i)[0],this.ctx.fillStyle=pt(i.color),this.ctx.textBaseline="middle",this.ctx.textAlign="right",y=new s(r.bounds.left,r.bounds.top+it(r.styles.paddingTop,r.bounds.width),r.bounds.width,function(e,t){return qe(e)&&"normal"===e.value?1.2*t:e.type===d.NUMBER_TOKEN?t*e.number:et(e)?it(e,t):t}(i.lineHeight,i.fontSize.number)/2+1),this.renderTextWithLetterSpacing(new Zn(t.listValue,y),i.letterSpacing),this.ctx.textBaseline="bottom",this.ctx.textAlign="left"),o.label=20;case 20:return[2]}}))}))},e.prototype.renderStackContent=function(e){return n(this,void 0,void 0,(function(){var t,r,n,s,i,a,A,u,c,l,d,f,h,p,m;return o(this,(function(o){switch(o.label){case 0:return[4,this.renderNodeBackgroundAndBorders(e.element)];case 1:o.sent(),t=0,r=e.negativeZIndex,o.label=2;case 2:return t<r.length?(m=r[t],[4,this.renderStack(m)]):[3,5];case 3:o.sent(),o.label=4;case 4:return t++,[3,2];case 5:return[4,this.renderNodeContent(e.element)];case 6:o.sent(),n=0,s=e.nonInlineLevel,o.label=7;case 7:return n<s.length?(m=s[n],[4,this.renderNode(m)]):[3,10];case 8:o.sent(),o.label=9;case 9:return n++,[3,7];case 10:i=0,a=e.nonPositionedFloats,o.label=11;case 11:return i<a.length?(m=a[i],[4,this.renderStack(m)]):[3,14];case 12:o.sent(),o.label=13;case 13:return i++,[3,11];case 14:A=0,u=e.nonPositionedInlineLevel,o.label=15;case 15:return A<u.length?(m=u[A],[4,this.renderStack(m)]):[3,18];case 16:o.sent(),o.label=17;case 17:return A++,[3,15];case 18:c=0,l=e.inlineLevel,o.label=19;case 19:return c<l.length?(m=l[c],[4,this.renderNode(m)]):[3,22];case 20:o.sent(),o.label=21;case 21:return c++,[3,19];case 22:d=0,f=e.zeroOrAutoZIndexOrTransformedOrOpacity,o.label=23;case 23:return d<f.length?(m=f[d],[4,this.renderStack(m)]):[3,26];case 24:o.sent(),o.label=25;case 25:return d++,[3,23];case 26:h=0,p=e.positiveZIndex,o.label=27;case 27:return h<p.length?(m=p[h],[4,this.renderStack(m)]):[3,30];case 28:o.sent(),o.label=29;case 29:return h++,[3,27];case 30:return[2]}}))}))},e.prototype.mask=function(e){this.ctx.beginPath(),this.ctx.moveTo(0,0),this.ctx.lineTo(this.canvas.width,0),this.ctx.lineTo(this.canvas.width,this.canvas.height),this.ctx.lineTo(0,this.canvas.height),this.ctx.lineTo(0,0),this.formatPath(e.slice(0).reverse()),this.ctx.closePath()},e.prototype.path=function(e){this.ctx.beginPath(),this.formatPath(e),this.ctx.closePath()},e.prototype.formatPath=function(e){var t=this;e.forEach((function(e,r){var n=xs(e)?e.start:e;0===r?t.ctx.moveTo(n.x,n.y):t.ctx.lineTo(n.x,n.y),xs(e)&&t.ctx.bezierCurveTo(e.startControl.x,e.startControl.y,e.endControl.x,e.endControl.y,e.end.x,e.end.y)}))},e.prototype.renderRepeat=function(e,t,r,n){this.path(e),this.ctx.fillStyle=t,this.ctx.translate(r,n),this.ctx.fill(),this.ctx.translate(-r,-n)},e.prototype.resizeImage=function(e,t,r){if(e.width===t&&e.height===r)return e;var n=this.canvas.ownerDocument.createElement("canvas");return n.width=t,n.height=r,n.getContext("2d").drawImage(e,0,0,e.width,e.height,0,0,t,r),n},e.prototype.renderBackgroundImage=function(e){return n(this,void 0,void 0,(function(){var t,r,n,s,i,a;return o(this,(function(A){switch(A.label){case 0:t=e.styles.backgroundImage.length-1,r=function(r){var s,i,a,A,u,c,l,d,f,h,p,m,g,y,v,w,b,B,j,_,C,x,E,N,Q,F,U,S,L,T,H;return o(this,(function(o){switch(o.label){case 0:if(r.type!==Ct.URL)return[3,5];s=void 0,i=r.url,o.label=1;case 1:return o.trys.push([1,3,,4]),[4,n.options.cache.match(i)];case 2:return s=o.sent(),[3,4];case 3:return o.sent(),Ot.getInstance(n.options.id).error("Error loading background-image "+i),[3,4];case 4:return s&&(a=Ks(e,t,[s.width,s.height,s.width/s.height]),w=a[0],x=a[1],E=a[2],j=a[3],_=a[4],y=n.ctx.createPattern(n.resizeImage(s,j,_),"repeat"),n.renderRepeat(w,y,x,E)),[3,6];case 5:r.type===Ct.LINEAR_GRADIENT?(A=Ks(e,t,[null,null,null]),w=A[0],x=A[1],E=A[2],j=A[3],_=A[4],u=Ft(r.angle,j,_),c=u[0],l=u[1],d=u[2],f=u[3],h=u[4],(p=document.createElement("canvas")).width=j,p.height=_,m=p.getContext("2d"),g=m.createLinearGradient(l,f,d,h),Qt(r.stops,c).forEach((function(e){return g.addColorStop(e.stop,pt(e.color))})),m.fillStyle=g,m.fillRect(0,0,j,_),j>0&&_>0&&(y=n.ctx.createPattern(p,"repeat"),n.renderRepeat(w,y,x,E))):function(e){return e.type===Ct.RADIAL_GRADIENT}(r)&&(v=Ks(e,t,[null,null,null]),w=v[0],b=v[1],B=v[2],j=v[3],_=v[4],C=0===r.position.length?[nt]:r.position,x=it(C[0],j),E=it(C[C.length-1],_),N=function(e,t,r,n,o){var s=0,i=0;switch(e.size){case sr.CLOSEST_SIDE:e.shape===or.CIRCLE?s=i=Math.min(Math.abs(t),Math.abs(t-n),Math.abs(r),Math.abs(r-o)):e.shape===or.ELLIPSE&&(s=Math.min(Math.abs(t),Math.abs(t-n)),i=Math.min(Math.abs(r),Math.abs(r-o)));break;case sr.CLOSEST_CORNER:if(e.shape===or.CIRCLE)s=i=Math.min(Ut(t,r),Ut(t,r-o),Ut(t-n,r),Ut(t-n,r-o));else if(e.shape===or.ELLIPSE){var a=Math.min(Math.abs(r),Math.abs(r-o))/Math.min(Math.abs(t),Math.abs(t-n)),A=St(n,o,t,r,!0),u=A[0],c=A[1];i=a*(s=Ut(u-t,(c-r)/a))}break;case sr.FARTHEST_SIDE:e.shape===or.CIRCLE?s=i=Math.max(Math.abs(t),Math.abs(t-n),Math.abs(r),Math.abs(r-o)):e.shape===or.ELLIPSE&&(s=Math.max(Math.abs(t),Math.abs(t-n)),i=Math.max(Math.abs(r),Math.abs(r-o)));break;case sr.FARTHEST_CORNER:if(e.shape===or.CIRCLE)s=i=Math.max(Ut(t,r),Ut(t,r-o),Ut(t-n,r),Ut(t-n,r-o));else if(e.shape===or.ELLIPSE){a=Math.max(Math.abs(r),Math.abs(r-o))/Math.max(Math.abs(t),Math.abs(t-n));var l=St(n,o,t,r,!1);u=l[0],c=l[1],i=a*(s=Ut(u-t,(c-r)/a))}}return Array.isArray(e.size)&&(s=it(e.size[0],n),i=2===e.size.length?it(e.size[1],o):s),[s,i]}(r,x,E,j,_),Q=N[0],F=N[1],Q>0&&Q>0&&(U=n.ctx.createRadialGradient(b+x,B+E,0,b+x,B+E,Q),Qt(r.stops,2*Q).forEach((function(e){return U.addColorStop(e.stop,pt(e.color))})),n.path(w),n.ctx.fillStyle=U,Q!==F?(S=e.bounds.left+.5*e.bounds.width,L=e.bounds.top+.5*e.bounds.height,H=1/(T=F/Q),n.ctx.save(),n.ctx.translate(S,L),n.ctx.transform(1,0,0,T,0,0),n.ctx.translate(-S,-L),n.ctx.fillRect(b,H*(B-L)+L,j,_*H),n.ctx.restore()):n.ctx.fill())),o.label=6;case 6:return t--,[2]}}))},n=this,s=0,i=e.styles.backgroundImage.slice(0).reverse(),A.label=1;case 1:return s<i.length?(a=i[s],[5,r(a)]):[3,4];case 2:A.sent(),A.label=3;case 3:return s++,[3,1];case 4:return[2]}}))}))},e.prototype.renderSolidBorder=function(e,t,r){return n(this,void 0,void 0,(function(){return o(this,(function(n){return this.path(Os(r,t)),this.ctx.fillStyle=pt(e),this.ctx.fill(),[2]}))}))},e.prototype.renderDoubleBorder=function(e,t,r,s){return n(this,void 0,void 0,(function(){var n,i;return o(this,(function(o){switch(o.label){case 0:return t<3?[4,this.renderSolidBorder(e,r,s)]:[3,2];case 1:return o.sent(),[2];case 2:return n=function(e,t){switch(t){case 0:return Rs(e.topLeftBorderBox,e.topLeftBorderDoubleOuterBox,e.topRightBorderBox,e.topRightBorderDoubleOuterBox);case 1:return Rs(e.topRightBorderBox,e.topRightBorderDoubleOuterBox,e.bottomRightBorderBox,e.bottomRightBorderDoubleOuterBox);case 2:return Rs(e.bottomRightBorderBox,e.bottomRightBorderDoubleOuterBox,e.bottomLeftBorderBox,e.bottomLeftBorderDoubleOuterBox);case 3:default:return Rs(e.bottomLeftBorderBox,e.bottomLeftBorderDoubleOuterBox,e.topLeftBorderBox,e.topLeftBorderDoubleOuterBox)}}(s,r),this.path(n),this.ctx.fillStyle=pt(e),this.ctx.fill(),i=function(e,t){switch(t){case 0:return Rs(e.topLeftBorderDoubleInnerBox,e.topLeftPaddingBox,e.topRightBorderDoubleInnerBox,e.topRightPaddingBox);case 1:return Rs(e.topRightBorderDoubleInnerBox,e.topRightPaddingBox,e.bottomRightBorderDoubleInnerBox,e.bottomRightPaddingBox);case 2:return Rs(e.bottomRightBorderDoubleInnerBox,e.bottomRightPaddingBox,e.bottomLeftBorderDoubleInnerBox,e.bottomLeftPaddingBox);case 3:default:return Rs(e.bottomLeftBorderDoubleInnerBox,e.bottomLeftPaddingBox,e.topLeftBorderDoubleInnerBox,e.topLeftPaddingBox)}}(s,r),this.path(i),this.ctx.fill(),[2]}}))}))},e.prototype.renderNodeBackgroundAndBorders=function(e){return n(this,void 0,void 0,(function(){var t,r,n,s,i,a,A,u,c=this;return o(this,(function(o){switch(o.label){case 0:return this.applyEffects(e.effects,2),t=e.container.styles,r=!ht(t.backgroundColor)||t.backgroundImage.length,n=[{style:t.borderTopStyle,color:t.borderTopColor,width:t.borderTopWidth},{style:t.borderRightStyle,color:t.borderRightColor,width:t.borderRightWidth},{style:t.borderBottomStyle,color:t.borderBottomColor,width:t.borderBottomWidth},{style:t.borderLeftStyle,color:t.borderLeftColor,width:t.borderLeftWidth}],s=$s(Gs(t.backgroundClip,0),e.curves),r||t.boxShadow.length?(this.ctx.save(),this.path(s),this.ctx.clip(),ht(t.backgroundColor)||(this.ctx.fillStyle=pt(t.backgroundColor),this.ctx.fill()),[4,this.renderBackgroundImage(e.container)]):[3,2];case 1:o.sent(),this.ctx.restore(),t.boxShadow.slice(0).reverse().forEach((function(t){c.ctx.save();var r,n,o,s,i,a=Qs(e.curves),A=t.inset?0:1e4,u=(r=a,n=-A+(t.inset?1:-1)*t.spread.number,o=(t.inset?1:-1)*t.spread.number,s=t.spread.number*(t.inset?-2:2),i=t.spread.number*(t.inset?-2:2),r.map((function(e,t){switch(t){case 0:return e.add(n,o);case 1:return e.add(n+s,o);case 2:return e.add(n+s,o+i);case 3:return e.add(n,o+i)}return e})));t.inset?(c.path(a),c.ctx.clip(),c.mask(u)):(c.mask(a),c.ctx.clip(),c.path(u)),c.ctx.shadowOffsetX=t.offsetX.number+A,c.ctx.shadowOffsetY=t.offsetY.number,c.ctx.shadowColor=pt(t.color),c.ctx.shadowBlur=t.blur.number,c.ctx.fillStyle=t.inset?pt(t.color):"rgba(0,0,0,1)",c.ctx.fill(),c.ctx.restore()})),o.label=2;case 2:i=0,a=0,A=n,o.label=3;case 3:return a<A.length?(u=A[a]).style!==pr.NONE&&!ht(u.color)&&u.width>0?u.style!==pr.DASHED?[3,5]:[4,this.renderDashedDottedBorder(u.color,u.width,i,e.curves,pr.DASHED)]:[3,11]:[3,13];case 4:return o.sent(),[3,11];case 5:return u.style!==pr.DOTTED?[3,7]:[4,this.renderDashedDottedBorder(u.color,u.width,i,e.curves,pr.DOTTED)];case 6:return o.sent(),[3,11];case 7:return u.style!==pr.DOUBLE?[3,9]:[4,this.renderDoubleBorder(u.color,u.width,i,e.curves)];case 8:return o.sent(),[3,11];case 9:return[4,this.renderSolidBorder(u.color,i,e.curves)];case 10:o.sent(),o.label=11;case 11:i++,o.label=12;case 12:return a++,[3,3];case 13:return[2]}}))}))},e.prototype.renderDashedDottedBorder=function(e,t,r,s,i){return n(this,void 0,void 0,(function(){var n,a,A,u,c,l,d,f,h,p,m,g,y,v,w,b;return o(this,(function(o){return this.ctx.save(),n=function(e,t){switch(t){case 0:return ks(e.topLeftBorderStroke,e.topRightBorderStroke);case 1:return ks(e.topRightBorderStroke,e.bottomRightBorderStroke);case 2:return ks(e.bottomRightBorderStroke,e.bottomLeftBorderStroke);case 3:default:return ks(e.bottomLeftBorderStroke,e.topLeftBorderStroke)}}(s,r),a=Os(s,r),i===pr.DASHED&&(this.path(a),this.ctx.clip()),xs(a[0])?(A=a[0].start.x,u=a[0].start.y):(A=a[0].x,u=a[0].y),xs(a[1])?(c=a[1].end.x,l=a[1].end.y):(c=a[1].x,l=a[1].y),d=0===r||2===r?Math.abs(A-c):Math.abs(u-l),this.ctx.beginPath(),i===pr.DOTTED?this.formatPath(n):this.formatPath(a.slice(0,2)),f=t<3?3*t:2*t,h=t<3?2*t:t,i===pr.DOTTED&&(f=t,h=t),p=!0,d<=2*f?p=!1:d<=2*f+h?(f*=m=d/(2*f+h),h*=m):(g=Math.floor((d+h)/(f+h)),y=(d-g*f)/(g-1),h=(v=(d-(g+1)*f)/g)<=0||Math.abs(h-y)<Math.abs(h-v)?y:v),p&&(i===pr.DOTTED?this.ctx.setLineDash([0,f+h]):this.ctx.setLineDash([f,h])),i===pr.DOTTED?(this.ctx.lineCap="round",this.ctx.lineWidth=t):this.ctx.lineWidth=2*t+1.1,this.ctx.strokeStyle=pt(e),this.ctx.stroke(),this.ctx.setLineDash([]),i===pr.DASHED&&(xs(a[0])&&(w=a[3],b=a[0],this.ctx.beginPath(),this.formatPath([new js(w.end.x,w.end.y),new js(b.start.x,b.start.y)]),this.ctx.stroke()),xs(a[1])&&(w=a[1],b=a[2],this.ctx.beginPath(),this.formatPath([new js(w.end.x,w.end.y),new js(b.start.x,b.start.y)]),this.ctx.stroke())),this.ctx.restore(),[2]}))}))},e.prototype.render=function(e){return n(this,void 0,void 0,(function(){var t;return o(this,(function(r){switch(r.label){case 0:return this.options.backgroundColor&&(this.ctx.fillStyle=pt(this.options.backgroundColor),this.ctx.fillRect(this.options.x-this.options.scrollX,this.options.y-this.options.scrollY,this.options.width,this.options.height)),n=new Hs(e,[]),o=new Ts(n),Is(n,o,o,s=[]),Ps(n.container,s),t=o,[4,this.renderStack(t)];case 1:return r.sent(),this.applyEffects([],2),[2,this.canvas]}var n,o,s}))}))},e}(),Zs=function(e){return e instanceof bo||e instanceof wo||e instanceof vo&&e.type!==mo&&e.type!==po},$s=function(e,t){switch(e){case bt.BORDER_BOX:return Qs(t);case bt.CONTENT_BOX:return function(e){return[e.topLeftContentBox,e.topRightContentBox,e.bottomRightContentBox,e.bottomLeftContentBox]}(t);case bt.PADDING_BOX:default:return Fs(t)}},ei=function(e){switch(e){case an.CENTER:return"center";case an.RIGHT:return"right";case an.LEFT:default:return"left"}},ti=function(){function e(e){this.canvas=e.canvas?e.canvas:document.createElement("canvas"),this.ctx=this.canvas.getContext("2d"),this.options=e,this.canvas.width=Math.floor(e.width*e.scale),this.canvas.height=Math.floor(e.height*e.scale),this.canvas.style.width=e.width+"px",this.canvas.style.height=e.height+"px",this.ctx.scale(this.options.scale,this.options.scale),this.ctx.translate(-e.x+e.scrollX,-e.y+e.scrollY),Ot.getInstance(e.id).debug("EXPERIMENTAL ForeignObject renderer initialized ("+e.width+"x"+e.height+" at "+e.x+","+e.y+") with scale "+e.scale)}return e.prototype.render=function(e){return n(this,void 0,void 0,(function(){var t,r;return o(this,(function(n){switch(n.label){case 0:return t=Ht(Math.max(this.options.windowWidth,this.options.width)*this.options.scale,Math.max(this.options.windowHeight,this.options.height)*this.options.scale,this.options.scrollX*this.options.scale,this.options.scrollY*this.options.scale,e),[4,ri(t)];case 1:return r=n.sent(),this.options.backgroundColor&&(this.ctx.fillStyle=pt(this.options.backgroundColor),this.ctx.fillRect(0,0,this.options.width*this.options.scale,this.options.height*this.options.scale)),this.ctx.drawImage(r,-this.options.x*this.options.scale,-this.options.y*this.options.scale),[2,this.canvas]}}))}))},e}(),ri=function(e){return new Promise((function(t,r){var n=new Image;n.onload=function(){t(n)},n.onerror=r,n.src="data:image/svg+xml;charset=utf-8,"+encodeURIComponent((new XMLSerializer).serializeToString(e))}))},ni=function(e){return ft(Ke.create(e).parseComponentValue())};"undefined"!=typeof window&&kt.setContext(window);var oi=function(e,t){return n(undefined,void 0,void 0,(function(){var n,a,A,u,c,l,d,f,h,p,m,g,y,v,w,b,B,j,_,C,x,E,N;return o(this,(function(o){switch(o.label){case 0:if(!(n=e.ownerDocument))throw new Error("Element is not attached to a Document");if(!(a=n.defaultView))throw new Error("Document is not attached to a Window");return A=(Math.round(1e3*Math.random())+Date.now()).toString(16),u=Oo(e)||"HTML"===e.tagName?function(e){var t=e.body,r=e.documentElement;if(!t||!r)throw new Error("Unable to get document size");var n=Math.max(Math.max(t.scrollWidth,r.scrollWidth),Math.max(t.offsetWidth,r.offsetWidth),Math.max(t.clientWidth,r.clientWidth)),o=Math.max(Math.max(t.scrollHeight,r.scrollHeight),Math.max(t.offsetHeight,r.offsetHeight),Math.max(t.clientHeight,r.clientHeight));return new s(0,0,n,o)}(n):i(e),c=u.width,l=u.height,d=u.left,f=u.top,h=r({},{allowTaint:!1,imageTimeout:15e3,proxy:void 0,useCORS:!1},t),p={backgroundColor:"#ffffff",cache:t.cache?t.cache:kt.create(A,h),logging:!0,removeContainer:!0,foreignObjectRendering:!1,scale:a.devicePixelRatio||1,windowWidth:a.innerWidth,windowHeight:a.innerHeight,scrollX:a.pageXOffset,scrollY:a.pageYOffset,x:d,y:f,width:Math.ceil(c),height:Math.ceil(l),id:A},m=r({},p,h,t),g=new s(m.scrollX,m.scrollY,m.windowWidth,m.windowHeight),Ot.create({id:A,enabled:m.logging}),Ot.getInstance(A).debug("Starting document clone"),y=new As(e,{id:A,onclone:m.onclone,ignoreElements:m.ignoreElements,inlineImages:m.foreignObjectRendering,copyStyles:m.foreignObjectRendering}),(v=y.clonedReferenceElement)?[4,y.toIFrame(n,g)]:[2,Promise.reject("Unable to find element in cloned iframe")];case 1:return w=o.sent(),b=n.documentElement?ni(getComputedStyle(n.documentElement).backgroundColor):_t.TRANSPARENT,B=n.body?ni(getComputedStyle(n.body).backgroundColor):_t.TRANSPARENT,j=t.backgroundColor,_="string"==typeof j?ni(j):null===j?_t.TRANSPARENT:4294967295,C=e===n.documentElement?ht(b)?ht(B)?_:B:b:_,x={id:A,cache:m.cache,canvas:m.canvas,backgroundColor:C,scale:m.scale,x:m.x,y:m.y,scrollX:m.scrollX,scrollY:m.scrollY,width:m.width,height:m.height,windowWidth:m.windowWidth,windowHeight:m.windowHeight},m.foreignObjectRendering?(Ot.getInstance(A).debug("Document cloned, using foreign object rendering"),[4,new ti(x).render(v)]):[3,3];case 2:return E=o.sent(),[3,5];case 3:return Ot.getInstance(A).debug("Document cloned, using computed rendering"),kt.attachInstance(m.cache),Ot.getInstance(A).debug("Starting DOM parsing"),N=Eo(v),kt.detachInstance(),C===N.styles.backgroundColor&&(N.styles.backgroundColor=_t.TRANSPARENT),Ot.getInstance(A).debug("Starting renderer"),[4,new Ys(x).render(N)];case 4:E=o.sent(),o.label=5;case 5:return!0===m.removeContainer&&(As.destroy(w)||Ot.getInstance(A).error("Cannot detach cloned iframe as it is not in the DOM anymore")),Ot.getInstance(A).debug("Finished rendering"),Ot.destroy(A),kt.destroy(A),[2,E]}}))}))};return function(e,t){return void 0===t&&(t={}),oi(e,t)}}()},"./node_modules/jspdf/dist/jspdf.es.min.js":function(e,t,r){"use strict";r.r(t),r.d(t,{AcroForm:function(){return _e},AcroFormAppearance:function(){return we},AcroFormButton:function(){return fe},AcroFormCheckBox:function(){return ge},AcroFormChoiceField:function(){return ue},AcroFormComboBox:function(){return le},AcroFormEditBox:function(){return de},AcroFormListBox:function(){return ce},AcroFormPasswordField:function(){return ve},AcroFormPushButton:function(){return he},AcroFormRadioButton:function(){return pe},AcroFormTextField:function(){return ye},GState:function(){return U},ShadingPattern:function(){return L},TilingPattern:function(){return T},jsPDF:function(){return H}});var n=r("./node_modules/fflate/esm/browser.js"),o=function(){return"undefined"!=typeof window?window:"undefined"!=typeof global?global:"undefined"!=typeof self?self:this}();function s(){o.console&&"function"==typeof o.console.log&&o.console.log.apply(o.console,arguments)}var i={log:s,warn:function(e){o.console&&("function"==typeof o.console.warn?o.console.warn.apply(o.console,arguments):s.call(null,arguments))},error:function(e){o.console&&("function"==typeof o.console.error?o.console.error.apply(o.console,arguments):s(e))}};function a(e,t,r){var n=new XMLHttpRequest;n.open("GET",e),n.responseType="blob",n.onload=function(){d(n.response,t,r)},n.onerror=function(){i.error("could not download file")},n.send()}function A(e){var t=new XMLHttpRequest;t.open("HEAD",e,!1);try{t.send()}catch(e){}return t.status>=200&&t.status<=299}function u(e){try{e.dispatchEvent(new MouseEvent("click"))}catch(r){var t=document.createEvent("MouseEvents");t.initMouseEvent("click",!0,!0,window,0,0,0,80,20,!1,!1,!1,!1,0,null),e.dispatchEvent(t)}}var c,l,d=o.saveAs||("object"!=typeof window||window!==o?function(){}:"undefined"!=typeof HTMLAnchorElement&&"download"in HTMLAnchorElement.prototype?function(e,t,r){var n=o.URL||o.webkitURL,s=document.createElement("a");t=t||e.name||"download",s.download=t,s.rel="noopener","string"==typeof e?(s.href=e,s.origin!==location.origin?A(s.href)?a(e,t,r):u(s,s.target="_blank"):u(s)):(s.href=n.createObjectURL(e),setTimeout((function(){n.revokeObjectURL(s.href)}),4e4),setTimeout((function(){u(s)}),0))}:"msSaveOrOpenBlob"in navigator?function(e,t,r){if(t=t||e.name||"download","string"==typeof e)if(A(e))a(e,t,r);else{var n=document.createElement("a");n.href=e,n.target="_blank",setTimeout((function(){u(n)}))}else navigator.msSaveOrOpenBlob(function(e,t){return void 0===t?t={autoBom:!1}:"object"!=typeof t&&(i.warn("Deprecated: Expected third argument to be a object"),t={autoBom:!t}),t.autoBom&&/^\s*(?:text\/\S*|application\/xml|\S*\/\S*\+xml)\s*;.*charset\s*=\s*utf-8/i.test(e.type)?new Blob([String.fromCharCode(65279),e],{type:e.type}):e}(e,r),t)}:function(e,t,r,n){if((n=n||open("","_blank"))&&(n.document.title=n.document.body.innerText="downloading..."),"string"==typeof e)return a(e,t,r);var s="application/octet-stream"===e.type,i=/constructor/i.test(o.HTMLElement)||o.safari,A=/CriOS\/[\d]+/.test(navigator.userAgent);if((A||s&&i)&&"object"==typeof FileReader){var u=new FileReader;u.onloadend=function(){var e=u.result;e=A?e:e.replace(/^data:[^;]*;/,"data:attachment/file;"),n?n.location.href=e:location=e,n=null},u.readAsDataURL(e)}else{var c=o.URL||o.webkitURL,l=c.createObjectURL(e);n?n.location=l:location.href=l,n=null,setTimeout((function(){c.revokeObjectURL(l)}),4e4)}});function f(e){var t;e=e||"",this.ok=!1,"#"==e.charAt(0)&&(e=e.substr(1,6)),e={aliceblue:"f0f8ff",antiquewhite:"faebd7",aqua:"00ffff",aquamarine:"7fffd4",azure:"f0ffff",beige:"f5f5dc",bisque:"ffe4c4",black:"000000",blanchedalmond:"ffebcd",blue:"0000ff",blueviolet:"8a2be2",brown:"a52a2a",burlywood:"deb887",cadetblue:"5f9ea0",chartreuse:"7fff00",chocolate:"d2691e",coral:"ff7f50",cornflowerblue:"6495ed",cornsilk:"fff8dc",crimson:"dc143c",cyan:"00ffff",darkblue:"00008b",darkcyan:"008b8b",darkgoldenrod:"b8860b",darkgray:"a9a9a9",darkgreen:"006400",darkkhaki:"bdb76b",darkmagenta:"8b008b",darkolivegreen:"556b2f",darkorange:"ff8c00",darkorchid:"9932cc",darkred:"8b0000",darksalmon:"e9967a",darkseagreen:"8fbc8f",darkslateblue:"483d8b",darkslategray:"2f4f4f",darkturquoise:"00ced1",darkviolet:"9400d3",deeppink:"ff1493",deepskyblue:"00bfff",dimgray:"696969",dodgerblue:"1e90ff",feldspar:"d19275",firebrick:"b22222",floralwhite:"fffaf0",forestgreen:"228b22",fuchsia:"ff00ff",gainsboro:"dcdcdc",ghostwhite:"f8f8ff",gold:"ffd700",goldenrod:"daa520",gray:"808080",green:"008000",greenyellow:"adff2f",honeydew:"f0fff0",hotpink:"ff69b4",indianred:"cd5c5c",indigo:"4b0082",ivory:"fffff0",khaki:"f0e68c",lavender:"e6e6fa",lavenderblush:"fff0f5",lawngreen:"7cfc00",lemonchiffon:"fffacd",lightblue:"add8e6",lightcoral:"f08080",lightcyan:"e0ffff",lightgoldenrodyellow:"fafad2",lightgrey:"d3d3d3",lightgreen:"90ee90",lightpink:"ffb6c1",lightsalmon:"ffa07a",lightseagreen:"20b2aa",lightskyblue:"87cefa",lightslateblue:"8470ff",lightslategray:"778899",lightsteelblue:"b0c4de",lightyellow:"ffffe0",lime:"00ff00",limegreen:"32cd32",linen:"faf0e6",magenta:"ff00ff",maroon:"800000",mediumaquamarine:"66cdaa",mediumblue:"0000cd",mediumorchid:"ba55d3",mediumpurple:"9370d8",mediumseagreen:"3cb371",mediumslateblue:"7b68ee",mediumspringgreen:"00fa9a",mediumturquoise:"48d1cc",mediumvioletred:"c71585",midnightblue:"191970",mintcream:"f5fffa",mistyrose:"ffe4e1",moccasin:"ffe4b5",navajowhite:"ffdead",navy:"000080",oldlace:"fdf5e6",olive:"808000",olivedrab:"6b8e23",orange:"ffa500",orangered:"ff4500",orchid:"da70d6",palegoldenrod:"eee8aa",palegreen:"98fb98",paleturquoise:"afeeee",palevioletred:"d87093",papayawhip:"ffefd5",peachpuff:"ffdab9",peru:"cd853f",pink:"ffc0cb",plum:"dda0dd",powderblue:"b0e0e6",purple:"800080",red:"ff0000",rosybrown:"bc8f8f",royalblue:"4169e1",saddlebrown:"8b4513",salmon:"fa8072",sandybrown:"f4a460",seagreen:"2e8b57",seashell:"fff5ee",sienna:"a0522d",silver:"c0c0c0",skyblue:"87ceeb",slateblue:"6a5acd",slategray:"708090",snow:"fffafa",springgreen:"00ff7f",steelblue:"4682b4",tan:"d2b48c",teal:"008080",thistle:"d8bfd8",tomato:"ff6347",turquoise:"40e0d0",violet:"ee82ee",violetred:"d02090",wheat:"f5deb3",white:"ffffff",whitesmoke:"f5f5f5",yellow:"ffff00",yellowgreen:"9acd32"}[e=(e=e.replace(/ /g,"")).toLowerCase()]||e;for(var r=[{re:/^rgb\((\d{1,3}),\s*(\d{1,3}),\s*(\d{1,3})\)$/,example:["rgb(123, 234, 45)","rgb(255,234,245)"],process:function(e){return[parseInt(e[1]),parseInt(e[2]),parseInt(e[3])]}},{re:/^(\w{2})(\w{2})(\w{2})$/,example:["#00ff00","336699"],process:function(e){return[parseInt(e[1],16),parseInt(e[2],16),parseInt(e[3],16)]}},{re:/^(\w{1})(\w{1})(\w{1})$/,example:["#fb0","f0f"],process:function(e){return[parseInt(e[1]+e[1],16),parseInt(e[2]+e[2],16),parseInt(e[3]+e[3],16)]}}],n=0;n<r.length;n++){var o=r[n].re,s=r[n].process,i=o.exec(e);i&&(t=s(i),this.r=t[0],this.g=t[1],this.b=t[2],this.ok=!0)}this.r=this.r<0||isNaN(this.r)?0:this.r>255?255:this.r,this.g=this.g<0||isNaN(this.g)?0:this.g>255?255:this.g,this.b=this.b<0||isNaN(this.b)?0:this.b>255?255:this.b,this.toRGB=function(){return"rgb("+this.r+", "+this.g+", "+this.b+")"},this.toHex=function(){var e=this.r.toString(16),t=this.g.toString(16),r=this.b.toString(16);return 1==e.length&&(e="0"+e),1==t.length&&(t="0"+t),1==r.length&&(r="0"+r),"#"+e+t+r}}function h(e,t){var r=e[0],n=e[1],o=e[2],s=e[3];r=m(r,n,o,s,t[0],7,-680876936),s=m(s,r,n,o,t[1],12,-389564586),o=m(o,s,r,n,t[2],17,606105819),n=m(n,o,s,r,t[3],22,-1044525330),r=m(r,n,o,s,t[4],7,-176418897),s=m(s,r,n,o,t[5],12,1200080426),o=m(o,s,r,n,t[6],17,-1473231341),n=m(n,o,s,r,t[7],22,-45705983),r=m(r,n,o,s,t[8],7,1770035416),s=m(s,r,n,o,t[9],12,-1958414417),o=m(o,s,r,n,t[10],17,-42063),n=m(n,o,s,r,t[11],22,-1990404162),r=m(r,n,o,s,t[12],7,1804603682),s=m(s,r,n,o,t[13],12,-40341101),o=m(o,s,r,n,t[14],17,-1502002290),r=g(r,n=m(n,o,s,r,t[15],22,1236535329),o,s,t[1],5,-165796510),s=g(s,r,n,o,t[6],9,-1069501632),o=g(o,s,r,n,t[11],14,643717713),n=g(n,o,s,r,t[0],20,-373897302),r=g(r,n,o,s,t[5],5,-701558691),s=g(s,r,n,o,t[10],9,38016083),o=g(o,s,r,n,t[15],14,-660478335),n=g(n,o,s,r,t[4],20,-405537848),r=g(r,n,o,s,t[9],5,568446438),s=g(s,r,n,o,t[14],9,-1019803690),o=g(o,s,r,n,t[3],14,-187363961),n=g(n,o,s,r,t[8],20,1163531501),r=g(r,n,o,s,t[13],5,-1444681467),s=g(s,r,n,o,t[2],9,-51403784),o=g(o,s,r,n,t[7],14,1735328473),r=y(r,n=g(n,o,s,r,t[12],20,-1926607734),o,s,t[5],4,-378558),s=y(s,r,n,o,t[8],11,-2022574463),o=y(o,s,r,n,t[11],16,1839030562),n=y(n,o,s,r,t[14],23,-35309556),r=y(r,n,o,s,t[1],4,-1530992060),s=y(s,r,n,o,t[4],11,1272893353),o=y(o,s,r,n,t[7],16,-155497632),n=y(n,o,s,r,t[10],23,-1094730640),r=y(r,n,o,s,t[13],4,681279174),s=y(s,r,n,o,t[0],11,-358537222),o=y(o,s,r,n,t[3],16,-722521979),n=y(n,o,s,r,t[6],23,76029189),r=y(r,n,o,s,t[9],4,-640364487),s=y(s,r,n,o,t[12],11,-421815835),o=y(o,s,r,n,t[15],16,530742520),r=v(r,n=y(n,o,s,r,t[2],23,-995338651),o,s,t[0],6,-198630844),s=v(s,r,n,o,t[7],10,1126891415),o=v(o,s,r,n,t[14],15,-1416354905),n=v(n,o,s,r,t[5],21,-57434055),r=v(r,n,o,s,t[12],6,1700485571),s=v(s,r,n,o,t[3],10,-1894986606),o=v(o,s,r,n,t[10],15,-1051523),n=v(n,o,s,r,t[1],21,-2054922799),r=v(r,n,o,s,t[8],6,1873313359),s=v(s,r,n,o,t[15],10,-30611744),o=v(o,s,r,n,t[6],15,-1560198380),n=v(n,o,s,r,t[13],21,1309151649),r=v(r,n,o,s,t[4],6,-145523070),s=v(s,r,n,o,t[11],10,-1120210379),o=v(o,s,r,n,t[2],15,718787259),n=v(n,o,s,r,t[9],21,-343485551),e[0]=x(r,e[0]),e[1]=x(n,e[1]),e[2]=x(o,e[2]),e[3]=x(s,e[3])}function p(e,t,r,n,o,s){return t=x(x(t,e),x(n,s)),x(t<<o|t>>>32-o,r)}function m(e,t,r,n,o,s,i){return p(t&r|~t&n,e,t,o,s,i)}function g(e,t,r,n,o,s,i){return p(t&n|r&~n,e,t,o,s,i)}function y(e,t,r,n,o,s,i){return p(t^r^n,e,t,o,s,i)}function v(e,t,r,n,o,s,i){return p(r^(t|~n),e,t,o,s,i)}function w(e){var t,r=e.length,n=[1732584193,-271733879,-1732584194,271733878];for(t=64;t<=e.length;t+=64)h(n,b(e.substring(t-64,t)));e=e.substring(t-64);var o=[0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0];for(t=0;t<e.length;t++)o[t>>2]|=e.charCodeAt(t)<<(t%4<<3);if(o[t>>2]|=128<<(t%4<<3),t>55)for(h(n,o),t=0;t<16;t++)o[t]=0;return o[14]=8*r,h(n,o),n}function b(e){var t,r=[];for(t=0;t<64;t+=4)r[t>>2]=e.charCodeAt(t)+(e.charCodeAt(t+1)<<8)+(e.charCodeAt(t+2)<<16)+(e.charCodeAt(t+3)<<24);return r}c=o.atob.bind(o),l=o.btoa.bind(o);var B="0123456789abcdef".split("");function j(e){for(var t="",r=0;r<4;r++)t+=B[e>>8*r+4&15]+B[e>>8*r&15];return t}function _(e){return String.fromCharCode((255&e)>>0,(65280&e)>>8,(16711680&e)>>16,(4278190080&e)>>24)}function C(e){return w(e).map(_).join("")}function x(e,t){return e+t&4294967295}function E(e,t){var r,n,o,s;if(e!==r){for(var i=(o=e,s=1+(256/e.length>>0),new Array(s+1).join(o)),a=[],A=0;A<256;A++)a[A]=A;var u=0;for(A=0;A<256;A++){var c=a[A];u=(u+c+i.charCodeAt(A))%256,a[A]=a[u],a[u]=c}r=e,n=a}else a=n;var l=t.length,d=0,f=0,h="";for(A=0;A<l;A++)f=(f+(c=a[d=(d+1)%256]))%256,a[d]=a[f],a[f]=c,i=a[(a[d]+a[f])%256],h+=String.fromCharCode(t.charCodeAt(A)^i);return h}!function(e){for(var t=0;t<e.length;t++)e[t]=j(e[t]);e.join("")}(w("hello"));var N={print:4,modify:8,copy:16,"annot-forms":32};function Q(e,t,r,n){this.v=1,this.r=2;let o=192;e.forEach((function(e){if(void 0!==N.perm)throw new Error("Invalid permission: "+e);o+=N[e]})),this.padding="(¿N^NuAd\0NVÿú\b..\0¶Ðh>/\f©þdSiz";let s=(t+this.padding).substr(0,32),i=(r+this.padding).substr(0,32);this.O=this.processOwnerPassword(s,i),this.P=-(1+(255^o)),this.encryptionKey=C(s+this.O+this.lsbFirstWord(this.P)+this.hexToBytes(n)).substr(0,5),this.U=E(this.encryptionKey,this.padding)}function F(e){if("object"!=typeof e)throw new Error("Invalid Context passed to initialize PubSub (jsPDF-module)");var t={};this.subscribe=function(e,r,n){if(n=n||!1,"string"!=typeof e||"function"!=typeof r||"boolean"!=typeof n)throw new Error("Invalid arguments passed to PubSub.subscribe (jsPDF-module)");t.hasOwnProperty(e)||(t[e]={});var o=Math.random().toString(35);return t[e][o]=[r,!!n],o},this.unsubscribe=function(e){for(var r in t)if(t[r][e])return delete t[r][e],0===Object.keys(t[r]).length&&delete t[r],!0;return!1},this.publish=function(r){if(t.hasOwnProperty(r)){var n=Array.prototype.slice.call(arguments,1),s=[];for(var a in t[r]){var A=t[r][a];try{A[0].apply(e,n)}catch(e){o.console&&i.error("jsPDF PubSub Error",e.message,e)}A[1]&&s.push(a)}s.length&&s.forEach(this.unsubscribe)}},this.getTopics=function(){return t}}function U(e){if(!(this instanceof U))return new U(e);var t="opacity,stroke-opacity".split(",");for(var r in e)e.hasOwnProperty(r)&&t.indexOf(r)>=0&&(this[r]=e[r]);this.id="",this.objectNumber=-1}function S(e,t){this.gState=e,this.matrix=t,this.id="",this.objectNumber=-1}function L(e,t,r,n,o){if(!(this instanceof L))return new L(e,t,r,n,o);this.type="axial"===e?2:3,this.coords=t,this.colors=r,S.call(this,n,o)}function T(e,t,r,n,o){if(!(this instanceof T))return new T(e,t,r,n,o);this.boundingBox=e,this.xStep=t,this.yStep=r,this.stream="",this.cloneIndex=0,S.call(this,n,o)}function H(e){var t,r="string"==typeof arguments[0]?arguments[0]:"p",n=arguments[1],s=arguments[2],a=arguments[3],A=[],u=1,c=16,h="S",p=null;"object"==typeof(e=e||{})&&(r=e.orientation,n=e.unit||n,s=e.format||s,a=e.compress||e.compressPdf||a,null!==(p=e.encryption||null)&&(p.userPassword=p.userPassword||"",p.ownerPassword=p.ownerPassword||"",p.userPermissions=p.userPermissions||[]),u="number"==typeof e.userUnit?Math.abs(e.userUnit):1,void 0!==e.precision&&(t=e.precision),void 0!==e.floatPrecision&&(c=e.floatPrecision),h=e.defaultPathOperation||"S"),A=e.filters||(!0===a?["FlateEncode"]:A),n=n||"mm",r=(""+(r||"P")).toLowerCase();var m=e.putOnlyUsedFonts||!1,g={},y={internal:{},__private__:{}};y.__private__.PubSub=F;var v="1.3",w=y.__private__.getPdfVersion=function(){return v};y.__private__.setPdfVersion=function(e){v=e};var b={a0:[2383.94,3370.39],a1:[1683.78,2383.94],a2:[1190.55,1683.78],a3:[841.89,1190.55],a4:[595.28,841.89],a5:[419.53,595.28],a6:[297.64,419.53],a7:[209.76,297.64],a8:[147.4,209.76],a9:[104.88,147.4],a10:[73.7,104.88],b0:[2834.65,4008.19],b1:[2004.09,2834.65],b2:[1417.32,2004.09],b3:[1000.63,1417.32],b4:[708.66,1000.63],b5:[498.9,708.66],b6:[354.33,498.9],b7:[249.45,354.33],b8:[175.75,249.45],b9:[124.72,175.75],b10:[87.87,124.72],c0:[2599.37,3676.54],c1:[1836.85,2599.37],c2:[1298.27,1836.85],c3:[918.43,1298.27],c4:[649.13,918.43],c5:[459.21,649.13],c6:[323.15,459.21],c7:[229.61,323.15],c8:[161.57,229.61],c9:[113.39,161.57],c10:[79.37,113.39],dl:[311.81,623.62],letter:[612,792],"government-letter":[576,756],legal:[612,1008],"junior-legal":[576,360],ledger:[1224,792],tabloid:[792,1224],"credit-card":[153,243]};y.__private__.getPageFormats=function(){return b};var B=y.__private__.getPageFormat=function(e){return b[e]};s=s||"a4";var j={COMPAT:"compat",ADVANCED:"advanced"},_=j.COMPAT;function C(){this.saveGraphicsState(),ue(new Ke(_e,0,0,-_e,0,Ir()*_e).toString()+" cm"),this.setFontSize(this.getFontSize()/_e),h="n",_=j.ADVANCED}function x(){this.restoreGraphicsState(),h="S",_=j.COMPAT}var E=function(e,t){if("bold"==e&&"normal"==t||"bold"==e&&400==t||"normal"==e&&"italic"==t||"bold"==e&&"italic"==t)throw new Error("Invalid Combination of fontweight and fontstyle");return t&&e!==t&&(e=400==t?"italic"==e?"italic":"normal":700==t&&"italic"!==e?"bold":e+""+t),e};y.advancedAPI=function(e){var t=_===j.COMPAT;return t&&C.call(this),"function"!=typeof e||(e(this),t&&x.call(this)),this},y.compatAPI=function(e){var t=_===j.ADVANCED;return t&&x.call(this),"function"!=typeof e||(e(this),t&&C.call(this)),this},y.isAdvancedAPI=function(){return _===j.ADVANCED};var N,S=function(e){if(_!==j.ADVANCED)throw new Error(e+" is only available in 'advanced' API mode. You need to call advancedAPI() first.")},I=y.roundToPrecision=y.__private__.roundToPrecision=function(e,r){var n=t||r;if(isNaN(e)||isNaN(n))throw new Error("Invalid argument passed to jsPDF.roundToPrecision");return e.toFixed(n).replace(/0+$/,"")};N=y.hpf=y.__private__.hpf="number"==typeof c?function(e){if(isNaN(e))throw new Error("Invalid argument passed to jsPDF.hpf");return I(e,c)}:"smart"===c?function(e){if(isNaN(e))throw new Error("Invalid argument passed to jsPDF.hpf");return I(e,e>-1&&e<1?16:5)}:function(e){if(isNaN(e))throw new Error("Invalid argument passed to jsPDF.hpf");return I(e,16)};var P=y.f2=y.__private__.f2=function(e){if(isNaN(e))throw new Error("Invalid argument passed to jsPDF.f2");return I(e,2)},O=y.__private__.f3=function(e){if(isNaN(e))throw new Error("Invalid argument passed to jsPDF.f3");return I(e,3)},k=y.scale=y.__private__.scale=function(e){if(isNaN(e))throw new Error("Invalid argument passed to jsPDF.scale");return _===j.COMPAT?e*_e:_===j.ADVANCED?e:void 0},R=function(e){return _===j.COMPAT?Ir()-e:_===j.ADVANCED?e:void 0},M=function(e){return k(R(e))};y.__private__.setPrecision=y.setPrecision=function(e){"number"==typeof parseInt(e,10)&&(t=parseInt(e,10))};var D,K="00000000000000000000000000000000",z=y.__private__.getFileId=function(){return K},V=y.__private__.setFileId=function(e){return K=void 0!==e&&/^[a-fA-F0-9]{32}$/.test(e)?e.toUpperCase():K.split("").map((function(){return"ABCDEF0123456789".charAt(Math.floor(16*Math.random()))})).join(""),null!==p&&(Vt=new Q(p.userPermissions,p.userPassword,p.ownerPassword,K)),K};y.setFileId=function(e){return V(e),this},y.getFileId=function(){return z()};var q=y.__private__.convertDateToPDFDate=function(e){var t=e.getTimezoneOffset(),r=t<0?"+":"-",n=Math.floor(Math.abs(t/60)),o=Math.abs(t%60),s=[r,Y(n),"'",Y(o),"'"].join("");return["D:",e.getFullYear(),Y(e.getMonth()+1),Y(e.getDate()),Y(e.getHours()),Y(e.getMinutes()),Y(e.getSeconds()),s].join("")},G=y.__private__.convertPDFDateToDate=function(e){var t=parseInt(e.substr(2,4),10),r=parseInt(e.substr(6,2),10)-1,n=parseInt(e.substr(8,2),10),o=parseInt(e.substr(10,2),10),s=parseInt(e.substr(12,2),10),i=parseInt(e.substr(14,2),10);return new Date(t,r,n,o,s,i,0)},X=y.__private__.setCreationDate=function(e){var t;if(void 0===e&&(e=new Date),e instanceof Date)t=q(e);else{if(!/^D:(20[0-2][0-9]|203[0-7]|19[7-9][0-9])(0[0-9]|1[0-2])([0-2][0-9]|3[0-1])(0[0-9]|1[0-9]|2[0-3])(0[0-9]|[1-5][0-9])(0[0-9]|[1-5][0-9])(\+0[0-9]|\+1[0-4]|-0[0-9]|-1[0-1])'(0[0-9]|[1-5][0-9])'?$/.test(e))throw new Error("Invalid argument passed to jsPDF.setCreationDate");t=e}return D=t},W=y.__private__.getCreationDate=function(e){var t=D;return"jsDate"===e&&(t=G(D)),t};y.setCreationDate=function(e){return X(e),this},y.getCreationDate=function(e){return W(e)};var J,Y=y.__private__.padd2=function(e){return("0"+parseInt(e)).slice(-2)},Z=y.__private__.padd2Hex=function(e){return("00"+(e=e.toString())).substr(e.length)},$=0,ee=[],te=[],re=0,ne=[],oe=[],se=!1,ie=te,ae=function(){$=0,re=0,te=[],ee=[],ne=[],Ye=Xe(),Ze=Xe()};y.__private__.setCustomOutputDestination=function(e){se=!0,ie=e};var Ae=function(e){se||(ie=e)};y.__private__.resetCustomOutputDestination=function(){se=!1,ie=te};var ue=y.__private__.out=function(e){return e=e.toString(),re+=e.length+1,ie.push(e),ie},ce=y.__private__.write=function(e){return ue(1===arguments.length?e.toString():Array.prototype.join.call(arguments," "))},le=y.__private__.getArrayBuffer=function(e){for(var t=e.length,r=new ArrayBuffer(t),n=new Uint8Array(r);t--;)n[t]=e.charCodeAt(t);return r},de=[["Helvetica","helvetica","normal","WinAnsiEncoding"],["Helvetica-Bold","helvetica","bold","WinAnsiEncoding"],["Helvetica-Oblique","helvetica","italic","WinAnsiEncoding"],["Helvetica-BoldOblique","helvetica","bolditalic","WinAnsiEncoding"],["Courier","courier","normal","WinAnsiEncoding"],["Courier-Bold","courier","bold","WinAnsiEncoding"],["Courier-Oblique","courier","italic","WinAnsiEncoding"],["Courier-BoldOblique","courier","bolditalic","WinAnsiEncoding"],["Times-Roman","times","normal","WinAnsiEncoding"],["Times-Bold","times","bold","WinAnsiEncoding"],["Times-Italic","times","italic","WinAnsiEncoding"],["Times-BoldItalic","times","bolditalic","WinAnsiEncoding"],["ZapfDingbats","zapfdingbats","normal",null],["Symbol","symbol","normal",null]];y.__private__.getStandardFonts=function(){return de};var fe=e.fontSize||16;y.__private__.setFontSize=y.setFontSize=function(e){return fe=_===j.ADVANCED?e/_e:e,this};var he,pe=y.__private__.getFontSize=y.getFontSize=function(){return _===j.COMPAT?fe:fe*_e},me=e.R2L||!1;y.__private__.setR2L=y.setR2L=function(e){return me=e,this},y.__private__.getR2L=y.getR2L=function(){return me};var ge,ye=y.__private__.setZoomMode=function(e){if(/^\d*\.?\d*%$/.test(e))he=e;else if(isNaN(e)){if(-1===[void 0,null,"fullwidth","fullheight","fullpage","original"].indexOf(e))throw new Error('zoom must be Integer (e.g. 2), a percentage Value (e.g. 300%) or fullwidth, fullheight, fullpage, original. "'+e+'" is not recognized.');he=e}else he=parseInt(e,10)};y.__private__.getZoomMode=function(){return he};var ve,we=y.__private__.setPageMode=function(e){if(-1==[void 0,null,"UseNone","UseOutlines","UseThumbs","FullScreen"].indexOf(e))throw new Error('Page mode must be one of UseNone, UseOutlines, UseThumbs, or FullScreen. "'+e+'" is not recognized.');ge=e};y.__private__.getPageMode=function(){return ge};var be=y.__private__.setLayoutMode=function(e){if(-1==[void 0,null,"continuous","single","twoleft","tworight","two"].indexOf(e))throw new Error('Layout mode must be one of continuous, single, twoleft, tworight. "'+e+'" is not recognized.');ve=e};y.__private__.getLayoutMode=function(){return ve},y.__private__.setDisplayMode=y.setDisplayMode=function(e,t,r){return ye(e),be(t),we(r),this};var Be={title:"",subject:"",author:"",keywords:"",creator:""};y.__private__.getDocumentProperty=function(e){if(-1===Object.keys(Be).indexOf(e))throw new Error("Invalid argument passed to jsPDF.getDocumentProperty");return Be[e]},y.__private__.getDocumentProperties=function(){return Be},y.__private__.setDocumentProperties=y.setProperties=y.setDocumentProperties=function(e){for(var t in Be)Be.hasOwnProperty(t)&&e[t]&&(Be[t]=e[t]);return this},y.__private__.setDocumentProperty=function(e,t){if(-1===Object.keys(Be).indexOf(e))throw new Error("Invalid arguments passed to jsPDF.setDocumentProperty");return Be[e]=t};var je,_e,Ce,xe,Ee,Ne={},Qe={},Fe=[],Ue={},Se={},Le={},Te={},He=null,Ie=0,Pe=[],Oe=new F(y),ke=e.hotfixes||[],Re={},Me={},De=[],Ke=function(e,t,r,n,o,s){if(!(this instanceof Ke))return new Ke(e,t,r,n,o,s);isNaN(e)&&(e=1),isNaN(t)&&(t=0),isNaN(r)&&(r=0),isNaN(n)&&(n=1),isNaN(o)&&(o=0),isNaN(s)&&(s=0),this._matrix=[e,t,r,n,o,s]};Object.defineProperty(Ke.prototype,"sx",{get:function(){return this._matrix[0]},set:function(e){this._matrix[0]=e}}),Object.defineProperty(Ke.prototype,"shy",{get:function(){return this._matrix[1]},set:function(e){this._matrix[1]=e}}),Object.defineProperty(Ke.prototype,"shx",{get:function(){return this._matrix[2]},set:function(e){this._matrix[2]=e}}),Object.defineProperty(Ke.prototype,"sy",{get:function(){return this._matrix[3]},set:function(e){this._matrix[3]=e}}),Object.defineProperty(Ke.prototype,"tx",{get:function(){return this._matrix[4]},set:function(e){this._matrix[4]=e}}),Object.defineProperty(Ke.prototype,"ty",{get:function(){return this._matrix[5]},set:function(e){this._matrix[5]=e}}),Object.defineProperty(Ke.prototype,"a",{get:function(){return this._matrix[0]},set:function(e){this._matrix[0]=e}}),Object.defineProperty(Ke.prototype,"b",{get:function(){return this._matrix[1]},set:function(e){this._matrix[1]=e}}),Object.defineProperty(Ke.prototype,"c",{get:function(){return this._matrix[2]},set:function(e){this._matrix[2]=e}}),Object.defineProperty(Ke.prototype,"d",{get:function(){return this._matrix[3]},set:function(e){this._matrix[3]=e}}),Object.defineProperty(Ke.prototype,"e",{get:function(){return this._matrix[4]},set:function(e){this._matrix[4]=e}}),Object.defineProperty(Ke.prototype,"f",{get:function(){return this._matrix[5]},set:function(e){this._matrix[5]=e}}),Object.defineProperty(Ke.prototype,"rotation",{get:function(){return Math.atan2(this.shx,this.sx)}}),Object.defineProperty(Ke.prototype,"scaleX",{get:function(){return this.decompose().scale.sx}}),Object.defineProperty(Ke.prototype,"scaleY",{get:function(){return this.decompose().scale.sy}}),Object.defineProperty(Ke.prototype,"isIdentity",{get:function(){return 1===this.sx&&0===this.shy&&0===this.shx&&1===this.sy&&0===this.tx&&0===this.ty}}),Ke.prototype.join=function(e){return[this.sx,this.shy,this.shx,this.sy,this.tx,this.ty].map(N).join(e)},Ke.prototype.multiply=function(e){var t=e.sx*this.sx+e.shy*this.shx,r=e.sx*this.shy+e.shy*this.sy,n=e.shx*this.sx+e.sy*this.shx,o=e.shx*this.shy+e.sy*this.sy,s=e.tx*this.sx+e.ty*this.shx+this.tx,i=e.tx*this.shy+e.ty*this.sy+this.ty;return new Ke(t,r,n,o,s,i)},Ke.prototype.decompose=function(){var e=this.sx,t=this.shy,r=this.shx,n=this.sy,o=this.tx,s=this.ty,i=Math.sqrt(e*e+t*t),a=(e/=i)*r+(t/=i)*n;r-=e*a,n-=t*a;var A=Math.sqrt(r*r+n*n);return a/=A,e*(n/=A)<t*(r/=A)&&(e=-e,t=-t,a=-a,i=-i),{scale:new Ke(i,0,0,A,0,0),translate:new Ke(1,0,0,1,o,s),rotate:new Ke(e,t,-t,e,0,0),skew:new Ke(1,0,a,1,0,0)}},Ke.prototype.toString=function(e){return this.join(" ")},Ke.prototype.inversed=function(){var e=this.sx,t=this.shy,r=this.shx,n=this.sy,o=this.tx,s=this.ty,i=1/(e*n-t*r),a=n*i,A=-t*i,u=-r*i,c=e*i;return new Ke(a,A,u,c,-a*o-u*s,-A*o-c*s)},Ke.prototype.applyToPoint=function(e){var t=e.x*this.sx+e.y*this.shx+this.tx,r=e.x*this.shy+e.y*this.sy+this.ty;return new Nr(t,r)},Ke.prototype.applyToRectangle=function(e){var t=this.applyToPoint(e),r=this.applyToPoint(new Nr(e.x+e.w,e.y+e.h));return new Qr(t.x,t.y,r.x-t.x,r.y-t.y)},Ke.prototype.clone=function(){var e=this.sx,t=this.shy,r=this.shx,n=this.sy,o=this.tx,s=this.ty;return new Ke(e,t,r,n,o,s)},y.Matrix=Ke;var ze=y.matrixMult=function(e,t){return t.multiply(e)},Ve=new Ke(1,0,0,1,0,0);y.unitMatrix=y.identityMatrix=Ve;var qe=function(e,t){if(!Se[e]){var r=(t instanceof L?"Sh":"P")+(Object.keys(Ue).length+1).toString(10);t.id=r,Se[e]=r,Ue[r]=t,Oe.publish("addPattern",t)}};y.ShadingPattern=L,y.TilingPattern=T,y.addShadingPattern=function(e,t){return S("addShadingPattern()"),qe(e,t),this},y.beginTilingPattern=function(e){S("beginTilingPattern()"),Ur(e.boundingBox[0],e.boundingBox[1],e.boundingBox[2]-e.boundingBox[0],e.boundingBox[3]-e.boundingBox[1],e.matrix)},y.endTilingPattern=function(e,t){S("endTilingPattern()"),t.stream=oe[J].join("\n"),qe(e,t),Oe.publish("endTilingPattern",t),De.pop().restore()};var Ge=y.__private__.newObject=function(){var e=Xe();return We(e,!0),e},Xe=y.__private__.newObjectDeferred=function(){return $++,ee[$]=function(){return re},$},We=function(e,t){return t="boolean"==typeof t&&t,ee[e]=re,t&&ue(e+" 0 obj"),e},Je=y.__private__.newAdditionalObject=function(){var e={objId:Xe(),content:""};return ne.push(e),e},Ye=Xe(),Ze=Xe(),$e=y.__private__.decodeColorString=function(e){var t=e.split(" ");if(2!==t.length||"g"!==t[1]&&"G"!==t[1])5!==t.length||"k"!==t[4]&&"K"!==t[4]||(t=[(1-t[0])*(1-t[3]),(1-t[1])*(1-t[3]),(1-t[2])*(1-t[3]),"r"]);else{var r=parseFloat(t[0]);t=[r,r,r,"r"]}for(var n="#",o=0;o<3;o++)n+=("0"+Math.floor(255*parseFloat(t[o])).toString(16)).slice(-2);return n},et=y.__private__.encodeColorString=function(e){var t;"string"==typeof e&&(e={ch1:e});var r=e.ch1,n=e.ch2,o=e.ch3,s=e.ch4,i="draw"===e.pdfColorType?["G","RG","K"]:["g","rg","k"];if("string"==typeof r&&"#"!==r.charAt(0)){var a=new f(r);if(a.ok)r=a.toHex();else if(!/^\d*\.?\d*$/.test(r))throw new Error('Invalid color "'+r+'" passed to jsPDF.encodeColorString.')}if("string"==typeof r&&/^#[0-9A-Fa-f]{3}$/.test(r)&&(r="#"+r[1]+r[1]+r[2]+r[2]+r[3]+r[3]),"string"==typeof r&&/^#[0-9A-Fa-f]{6}$/.test(r)){var A=parseInt(r.substr(1),16);r=A>>16&255,n=A>>8&255,o=255&A}if(void 0===n||void 0===s&&r===n&&n===o)if("string"==typeof r)t=r+" "+i[0];else switch(e.precision){case 2:t=P(r/255)+" "+i[0];break;case 3:default:t=O(r/255)+" "+i[0]}else if(void 0===s||"object"==typeof s){if(s&&!isNaN(s.a)&&0===s.a)return["1.","1.","1.",i[1]].join(" ");if("string"==typeof r)t=[r,n,o,i[1]].join(" ");else switch(e.precision){case 2:t=[P(r/255),P(n/255),P(o/255),i[1]].join(" ");break;default:case 3:t=[O(r/255),O(n/255),O(o/255),i[1]].join(" ")}}else if("string"==typeof r)t=[r,n,o,s,i[2]].join(" ");else switch(e.precision){case 2:t=[P(r),P(n),P(o),P(s),i[2]].join(" ");break;case 3:default:t=[O(r),O(n),O(o),O(s),i[2]].join(" ")}return t},tt=y.__private__.getFilters=function(){return A},rt=y.__private__.putStream=function(e){var t=(e=e||{}).data||"",r=e.filters||tt(),n=e.alreadyAppliedFilters||[],o=e.addLength1||!1,s=t.length,i=e.objectId,a=function(e){return e};if(null!==p&&void 0===i)throw new Error("ObjectId must be passed to putStream for file encryption");null!==p&&(a=Vt.encryptor(i,0));var A={};!0===r&&(r=["FlateEncode"]);var u=e.additionalKeyValues||[],c=(A=void 0!==H.API.processDataByFilters?H.API.processDataByFilters(t,r):{data:t,reverseChain:[]}).reverseChain+(Array.isArray(n)?n.join(" "):n.toString());if(0!==A.data.length&&(u.push({key:"Length",value:A.data.length}),!0===o&&u.push({key:"Length1",value:s})),0!=c.length)if(c.split("/").length-1==1)u.push({key:"Filter",value:c});else{u.push({key:"Filter",value:"["+c+"]"});for(var l=0;l<u.length;l+=1)if("DecodeParms"===u[l].key){for(var d=[],f=0;f<A.reverseChain.split("/").length-1;f+=1)d.push("null");d.push(u[l].value),u[l].value="["+d.join(" ")+"]"}}ue("<<");for(var h=0;h<u.length;h++)ue("/"+u[h].key+" "+u[h].value);ue(">>"),0!==A.data.length&&(ue("stream"),ue(a(A.data)),ue("endstream"))},nt=y.__private__.putPage=function(e){var t=e.number,r=e.data,n=e.objId,o=e.contentsObjId;We(n,!0),ue("<</Type /Page"),ue("/Parent "+e.rootDictionaryObjId+" 0 R"),ue("/Resources "+e.resourceDictionaryObjId+" 0 R"),ue("/MediaBox ["+parseFloat(N(e.mediaBox.bottomLeftX))+" "+parseFloat(N(e.mediaBox.bottomLeftY))+" "+N(e.mediaBox.topRightX)+" "+N(e.mediaBox.topRightY)+"]"),null!==e.cropBox&&ue("/CropBox ["+N(e.cropBox.bottomLeftX)+" "+N(e.cropBox.bottomLeftY)+" "+N(e.cropBox.topRightX)+" "+N(e.cropBox.topRightY)+"]"),null!==e.bleedBox&&ue("/BleedBox ["+N(e.bleedBox.bottomLeftX)+" "+N(e.bleedBox.bottomLeftY)+" "+N(e.bleedBox.topRightX)+" "+N(e.bleedBox.topRightY)+"]"),null!==e.trimBox&&ue("/TrimBox ["+N(e.trimBox.bottomLeftX)+" "+N(e.trimBox.bottomLeftY)+" "+N(e.trimBox.topRightX)+" "+N(e.trimBox.topRightY)+"]"),null!==e.artBox&&ue("/ArtBox ["+N(e.artBox.bottomLeftX)+" "+N(e.artBox.bottomLeftY)+" "+N(e.artBox.topRightX)+" "+N(e.artBox.topRightY)+"]"),"number"==typeof e.userUnit&&1!==e.userUnit&&ue("/UserUnit "+e.userUnit),Oe.publish("putPage",{objId:n,pageContext:Pe[t],pageNumber:t,page:r}),ue("/Contents "+o+" 0 R"),ue(">>"),ue("endobj");var s=r.join("\n");return _===j.ADVANCED&&(s+="\nQ"),We(o,!0),rt({data:s,filters:tt(),objectId:o}),ue("endobj"),n},ot=y.__private__.putPages=function(){var e,t,r=[];for(e=1;e<=Ie;e++)Pe[e].objId=Xe(),Pe[e].contentsObjId=Xe();for(e=1;e<=Ie;e++)r.push(nt({number:e,data:oe[e],objId:Pe[e].objId,contentsObjId:Pe[e].contentsObjId,mediaBox:Pe[e].mediaBox,cropBox:Pe[e].cropBox,bleedBox:Pe[e].bleedBox,trimBox:Pe[e].trimBox,artBox:Pe[e].artBox,userUnit:Pe[e].userUnit,rootDictionaryObjId:Ye,resourceDictionaryObjId:Ze}));We(Ye,!0),ue("<</Type /Pages");var n="/Kids [";for(t=0;t<Ie;t++)n+=r[t]+" 0 R ";ue(n+"]"),ue("/Count "+Ie),ue(">>"),ue("endobj"),Oe.publish("postPutPages")},st=function(e){var t=function(e,t){return-1!==e.indexOf(" ")?"("+Qt(e,t)+")":Qt(e,t)};Oe.publish("putFont",{font:e,out:ue,newObject:Ge,putStream:rt,pdfEscapeWithNeededParanthesis:t}),!0!==e.isAlreadyPutted&&(e.objectNumber=Ge(),ue("<<"),ue("/Type /Font"),ue("/BaseFont /"+t(e.postScriptName)),ue("/Subtype /Type1"),"string"==typeof e.encoding&&ue("/Encoding /"+e.encoding),ue("/FirstChar 32"),ue("/LastChar 255"),ue(">>"),ue("endobj"))},it=function(){for(var e in Ne)Ne.hasOwnProperty(e)&&(!1===m||!0===m&&g.hasOwnProperty(e))&&st(Ne[e])},at=function(e){e.objectNumber=Ge();var t=[];t.push({key:"Type",value:"/XObject"}),t.push({key:"Subtype",value:"/Form"}),t.push({key:"BBox",value:"["+[N(e.x),N(e.y),N(e.x+e.width),N(e.y+e.height)].join(" ")+"]"}),t.push({key:"Matrix",value:"["+e.matrix.toString()+"]"});var r=e.pages[1].join("\n");rt({data:r,additionalKeyValues:t,objectId:e.objectNumber}),ue("endobj")},At=function(){for(var e in Re)Re.hasOwnProperty(e)&&at(Re[e])},ut=function(e,t){var r,n=[],o=1/(t-1);for(r=0;r<1;r+=o)n.push(r);if(n.push(1),0!=e[0].offset){var s={offset:0,color:e[0].color};e.unshift(s)}if(1!=e[e.length-1].offset){var i={offset:1,color:e[e.length-1].color};e.push(i)}for(var a="",A=0,u=0;u<n.length;u++){for(r=n[u];r>e[A+1].offset;)A++;var c=e[A].offset,l=(r-c)/(e[A+1].offset-c),d=e[A].color,f=e[A+1].color;a+=Z(Math.round((1-l)*d[0]+l*f[0]).toString(16))+Z(Math.round((1-l)*d[1]+l*f[1]).toString(16))+Z(Math.round((1-l)*d[2]+l*f[2]).toString(16))}return a.trim()},ct=function(e,t){t||(t=21);var r=Ge(),n=ut(e.colors,t),o=[];o.push({key:"FunctionType",value:"0"}),o.push({key:"Domain",value:"[0.0 1.0]"}),o.push({key:"Size",value:"["+t+"]"}),o.push({key:"BitsPerSample",value:"8"}),o.push({key:"Range",value:"[0.0 1.0 0.0 1.0 0.0 1.0]"}),o.push({key:"Decode",value:"[0.0 1.0 0.0 1.0 0.0 1.0]"}),rt({data:n,additionalKeyValues:o,alreadyAppliedFilters:["/ASCIIHexDecode"],objectId:r}),ue("endobj"),e.objectNumber=Ge(),ue("<< /ShadingType "+e.type),ue("/ColorSpace /DeviceRGB");var s="/Coords ["+N(parseFloat(e.coords[0]))+" "+N(parseFloat(e.coords[1]))+" ";2===e.type?s+=N(parseFloat(e.coords[2]))+" "+N(parseFloat(e.coords[3])):s+=N(parseFloat(e.coords[2]))+" "+N(parseFloat(e.coords[3]))+" "+N(parseFloat(e.coords[4]))+" "+N(parseFloat(e.coords[5])),ue(s+="]"),e.matrix&&ue("/Matrix ["+e.matrix.toString()+"]"),ue("/Function "+r+" 0 R"),ue("/Extend [true true]"),ue(">>"),ue("endobj")},lt=function(e,t){var r=Xe(),n=Ge();t.push({resourcesOid:r,objectOid:n}),e.objectNumber=n;var o=[];o.push({key:"Type",value:"/Pattern"}),o.push({key:"PatternType",value:"1"}),o.push({key:"PaintType",value:"1"}),o.push({key:"TilingType",value:"1"}),o.push({key:"BBox",value:"["+e.boundingBox.map(N).join(" ")+"]"}),o.push({key:"XStep",value:N(e.xStep)}),o.push({key:"YStep",value:N(e.yStep)}),o.push({key:"Resources",value:r+" 0 R"}),e.matrix&&o.push({key:"Matrix",value:"["+e.matrix.toString()+"]"}),rt({data:e.stream,additionalKeyValues:o,objectId:e.objectNumber}),ue("endobj")},dt=function(e){var t;for(t in Ue)Ue.hasOwnProperty(t)&&(Ue[t]instanceof L?ct(Ue[t]):Ue[t]instanceof T&&lt(Ue[t],e))},ft=function(e){for(var t in e.objectNumber=Ge(),ue("<<"),e)switch(t){case"opacity":ue("/ca "+P(e[t]));break;case"stroke-opacity":ue("/CA "+P(e[t]))}ue(">>"),ue("endobj")},ht=function(){var e;for(e in Le)Le.hasOwnProperty(e)&&ft(Le[e])},pt=function(){for(var e in ue("/XObject <<"),Re)Re.hasOwnProperty(e)&&Re[e].objectNumber>=0&&ue("/"+e+" "+Re[e].objectNumber+" 0 R");Oe.publish("putXobjectDict"),ue(">>")},mt=function(){Vt.oid=Ge(),ue("<<"),ue("/Filter /Standard"),ue("/V "+Vt.v),ue("/R "+Vt.r),ue("/U <"+Vt.toHexString(Vt.U)+">"),ue("/O <"+Vt.toHexString(Vt.O)+">"),ue("/P "+Vt.P),ue(">>"),ue("endobj")},gt=function(){for(var e in ue("/Font <<"),Ne)Ne.hasOwnProperty(e)&&(!1===m||!0===m&&g.hasOwnProperty(e))&&ue("/"+e+" "+Ne[e].objectNumber+" 0 R");ue(">>")},yt=function(){if(Object.keys(Ue).length>0){for(var e in ue("/Shading <<"),Ue)Ue.hasOwnProperty(e)&&Ue[e]instanceof L&&Ue[e].objectNumber>=0&&ue("/"+e+" "+Ue[e].objectNumber+" 0 R");Oe.publish("putShadingPatternDict"),ue(">>")}},vt=function(e){if(Object.keys(Ue).length>0){for(var t in ue("/Pattern <<"),Ue)Ue.hasOwnProperty(t)&&Ue[t]instanceof y.TilingPattern&&Ue[t].objectNumber>=0&&Ue[t].objectNumber<e&&ue("/"+t+" "+Ue[t].objectNumber+" 0 R");Oe.publish("putTilingPatternDict"),ue(">>")}},wt=function(){if(Object.keys(Le).length>0){var e;for(e in ue("/ExtGState <<"),Le)Le.hasOwnProperty(e)&&Le[e].objectNumber>=0&&ue("/"+e+" "+Le[e].objectNumber+" 0 R");Oe.publish("putGStateDict"),ue(">>")}},bt=function(e){We(e.resourcesOid,!0),ue("<<"),ue("/ProcSet [/PDF /Text /ImageB /ImageC /ImageI]"),gt(),yt(),vt(e.objectOid),wt(),pt(),ue(">>"),ue("endobj")},Bt=function(){var e=[];it(),ht(),At(),dt(e),Oe.publish("putResources"),e.forEach(bt),bt({resourcesOid:Ze,objectOid:Number.MAX_SAFE_INTEGER}),Oe.publish("postPutResources")},jt=function(){Oe.publish("putAdditionalObjects");for(var e=0;e<ne.length;e++){var t=ne[e];We(t.objId,!0),ue(t.content),ue("endobj")}Oe.publish("postPutAdditionalObjects")},_t=function(e){Qe[e.fontName]=Qe[e.fontName]||{},Qe[e.fontName][e.fontStyle]=e.id},Ct=function(e,t,r,n,o){var s={id:"F"+(Object.keys(Ne).length+1).toString(10),postScriptName:e,fontName:t,fontStyle:r,encoding:n,isStandardFont:o||!1,metadata:{}};return Oe.publish("addFont",{font:s,instance:this}),Ne[s.id]=s,_t(s),s.id},xt=function(e){for(var t=0,r=de.length;t<r;t++){var n=Ct.call(this,e[t][0],e[t][1],e[t][2],de[t][3],!0);!1===m&&(g[n]=!0);var o=e[t][0].split("-");_t({id:n,fontName:o[0],fontStyle:o[1]||""})}Oe.publish("addFonts",{fonts:Ne,dictionary:Qe})},Et=function(e){return e.foo=function(){try{return e.apply(this,arguments)}catch(e){var t=e.stack||"";~t.indexOf(" at ")&&(t=t.split(" at ")[1]);var r="Error in function "+t.split("\n")[0].split("<")[0]+": "+e.message;if(!o.console)throw new Error(r);o.console.error(r,e),o.alert&&alert(r)}},e.foo.bar=e,e.foo},Nt=function(e,t){var r,n,o,s,i,a,A,u,c;if(o=(t=t||{}).sourceEncoding||"Unicode",i=t.outputEncoding,(t.autoencode||i)&&Ne[je].metadata&&Ne[je].metadata[o]&&Ne[je].metadata[o].encoding&&(s=Ne[je].metadata[o].encoding,!i&&Ne[je].encoding&&(i=Ne[je].encoding),!i&&s.codePages&&(i=s.codePages[0]),"string"==typeof i&&(i=s[i]),i)){for(A=!1,a=[],r=0,n=e.length;r<n;r++)(u=i[e.charCodeAt(r)])?a.push(String.fromCharCode(u)):a.push(e[r]),a[r].charCodeAt(0)>>8&&(A=!0);e=a.join("")}for(r=e.length;void 0===A&&0!==r;)e.charCodeAt(r-1)>>8&&(A=!0),r--;if(!A)return e;for(a=t.noBOM?[]:[254,255],r=0,n=e.length;r<n;r++){if((c=(u=e.charCodeAt(r))>>8)>>8)throw new Error("Character at position "+r+" of string '"+e+"' exceeds 16bits. Cannot be encoded into UCS-2 BE");a.push(c),a.push(u-(c<<8))}return String.fromCharCode.apply(void 0,a)},Qt=y.__private__.pdfEscape=y.pdfEscape=function(e,t){return Nt(e,t).replace(/\\/g,"\\\\").replace(/\(/g,"\\(").replace(/\)/g,"\\)")},Ft=y.__private__.beginPage=function(e){oe[++Ie]=[],Pe[Ie]={objId:0,contentsObjId:0,userUnit:Number(u),artBox:null,bleedBox:null,cropBox:null,trimBox:null,mediaBox:{bottomLeftX:0,bottomLeftY:0,topRightX:Number(e[0]),topRightY:Number(e[1])}},Lt(Ie),Ae(oe[J])},Ut=function(e,t){var n,o,a;switch(r=t||r,"string"==typeof e&&(n=B(e.toLowerCase()),Array.isArray(n)&&(o=n[0],a=n[1])),Array.isArray(e)&&(o=e[0]*_e,a=e[1]*_e),isNaN(o)&&(o=s[0],a=s[1]),(o>14400||a>14400)&&(i.warn("A page in a PDF can not be wider or taller than 14400 userUnit. jsPDF limits the width/height to 14400"),o=Math.min(14400,o),a=Math.min(14400,a)),s=[o,a],r.substr(0,1)){case"l":a>o&&(s=[a,o]);break;case"p":o>a&&(s=[a,o])}Ft(s),lr(cr),ue(vr),0!==Cr&&ue(Cr+" J"),0!==xr&&ue(xr+" j"),Oe.publish("addPage",{pageNumber:Ie})},St=function(e){e>0&&e<=Ie&&(oe.splice(e,1),Pe.splice(e,1),Ie--,J>Ie&&(J=Ie),this.setPage(J))},Lt=function(e){e>0&&e<=Ie&&(J=e)},Tt=y.__private__.getNumberOfPages=y.getNumberOfPages=function(){return oe.length-1},Ht=function(e,t,r){var n,o=void 0;return r=r||{},e=void 0!==e?e:Ne[je].fontName,t=void 0!==t?t:Ne[je].fontStyle,n=e.toLowerCase(),void 0!==Qe[n]&&void 0!==Qe[n][t]?o=Qe[n][t]:void 0!==Qe[e]&&void 0!==Qe[e][t]?o=Qe[e][t]:!1===r.disableWarning&&i.warn("Unable to look up font label for font '"+e+"', '"+t+"'. Refer to getFontList() for available fonts."),o||r.noFallback||null==(o=Qe.times[t])&&(o=Qe.times.normal),o},It=y.__private__.putInfo=function(){var e=Ge(),t=function(e){return e};for(var r in null!==p&&(t=Vt.encryptor(e,0)),ue("<<"),ue("/Producer ("+Qt(t("jsPDF "+H.version))+")"),Be)Be.hasOwnProperty(r)&&Be[r]&&ue("/"+r.substr(0,1).toUpperCase()+r.substr(1)+" ("+Qt(t(Be[r]))+")");ue("/CreationDate ("+Qt(t(D))+")"),ue(">>"),ue("endobj")},Pt=y.__private__.putCatalog=function(e){var t=(e=e||{}).rootDictionaryObjId||Ye;switch(Ge(),ue("<<"),ue("/Type /Catalog"),ue("/Pages "+t+" 0 R"),he||(he="fullwidth"),he){case"fullwidth":ue("/OpenAction [3 0 R /FitH null]");break;case"fullheight":ue("/OpenAction [3 0 R /FitV null]");break;case"fullpage":ue("/OpenAction [3 0 R /Fit]");break;case"original":ue("/OpenAction [3 0 R /XYZ null null 1]");break;default:var r=""+he;"%"===r.substr(r.length-1)&&(he=parseInt(he)/100),"number"==typeof he&&ue("/OpenAction [3 0 R /XYZ null null "+P(he)+"]")}switch(ve||(ve="continuous"),ve){case"continuous":ue("/PageLayout /OneColumn");break;case"single":ue("/PageLayout /SinglePage");break;case"two":case"twoleft":ue("/PageLayout /TwoColumnLeft");break;case"tworight":ue("/PageLayout /TwoColumnRight")}ge&&ue("/PageMode /"+ge),Oe.publish("putCatalog"),ue(">>"),ue("endobj")},Ot=y.__private__.putTrailer=function(){ue("trailer"),ue("<<"),ue("/Size "+($+1)),ue("/Root "+$+" 0 R"),ue("/Info "+($-1)+" 0 R"),null!==p&&ue("/Encrypt "+Vt.oid+" 0 R"),ue("/ID [ <"+K+"> <"+K+"> ]"),ue(">>")},kt=y.__private__.putHeader=function(){ue("%PDF-"+v),ue("%ºß¬à")},Rt=y.__private__.putXRef=function(){var e="0000000000";ue("xref"),ue("0 "+($+1)),ue("0000000000 65535 f ");for(var t=1;t<=$;t++)"function"==typeof ee[t]?ue((e+ee[t]()).slice(-10)+" 00000 n "):void 0!==ee[t]?ue((e+ee[t]).slice(-10)+" 00000 n "):ue("0000000000 00000 n ")},Mt=y.__private__.buildDocument=function(){ae(),Ae(te),Oe.publish("buildDocument"),kt(),ot(),jt(),Bt(),null!==p&&mt(),It(),Pt();var e=re;return Rt(),Ot(),ue("startxref"),ue(""+e),ue("%%EOF"),Ae(oe[J]),te.join("\n")},Dt=y.__private__.getBlob=function(e){return new Blob([le(e)],{type:"application/pdf"})},Kt=y.output=y.__private__.output=Et((function(e,t){switch("string"==typeof(t=t||{})?t={filename:t}:t.filename=t.filename||"generated.pdf",e){case void 0:return Mt();case"save":y.save(t.filename);break;case"arraybuffer":return le(Mt());case"blob":return Dt(Mt());case"bloburi":case"bloburl":if(void 0!==o.URL&&"function"==typeof o.URL.createObjectURL)return o.URL&&o.URL.createObjectURL(Dt(Mt()))||void 0;i.warn("bloburl is not supported by your system, because URL.createObjectURL is not supported by your browser.");break;case"datauristring":case"dataurlstring":var r="",n=Mt();try{r=l(n)}catch(e){r=l(unescape(encodeURIComponent(n)))}return"data:application/pdf;filename="+t.filename+";base64,"+r;case"pdfobjectnewwindow":if("[object Window]"===Object.prototype.toString.call(o)){var s='<html><style>html, body { padding: 0; margin: 0; } iframe { width: 100%; height: 100%; border: 0;}  </style><body><script src="'+(t.pdfObjectUrl||"https://cdnjs.cloudflare.com/ajax/libs/pdfobject/2.1.1/pdfobject.min.js")+'"><\/script><script >PDFObject.embed("'+this.output("dataurlstring")+'", '+JSON.stringify(t)+");<\/script></body></html>",a=o.open();return null!==a&&a.document.write(s),a}throw new Error("The option pdfobjectnewwindow just works in a browser-environment.");case"pdfjsnewwindow":if("[object Window]"===Object.prototype.toString.call(o)){var A='<html><style>html, body { padding: 0; margin: 0; } iframe { width: 100%; height: 100%; border: 0;}  </style><body><iframe id="pdfViewer" src="'+(t.pdfJsUrl||"examples/PDF.js/web/viewer.html")+"?file=&downloadName="+t.filename+'" width="500px" height="400px" /></body></html>',u=o.open();if(null!==u){u.document.write(A);var c=this;u.document.documentElement.querySelector("#pdfViewer").onload=function(){u.document.title=t.filename,u.document.documentElement.querySelector("#pdfViewer").contentWindow.PDFViewerApplication.open(c.output("bloburl"))}}return u}throw new Error("The option pdfjsnewwindow just works in a browser-environment.");case"dataurlnewwindow":if("[object Window]"!==Object.prototype.toString.call(o))throw new Error("The option dataurlnewwindow just works in a browser-environment.");var d='<html><style>html, body { padding: 0; margin: 0; } iframe { width: 100%; height: 100%; border: 0;}  </style><body><iframe src="'+this.output("datauristring",t)+'"></iframe></body></html>',f=o.open();if(null!==f&&(f.document.write(d),f.document.title=t.filename),f||"undefined"==typeof safari)return f;break;case"datauri":case"dataurl":return o.document.location.href=this.output("datauristring",t);default:return null}})),zt=function(e){return!0===Array.isArray(ke)&&ke.indexOf(e)>-1};switch(n){case"pt":_e=1;break;case"mm":_e=72/25.4;break;case"cm":_e=72/2.54;break;case"in":_e=72;break;case"px":_e=1==zt("px_scaling")?.75:96/72;break;case"pc":case"em":_e=12;break;case"ex":_e=6;break;default:throw new Error("Invalid unit: "+n)}var Vt=null;X(),V();var qt=function(e){return null!==p?Vt.encryptor(e,0):function(e){return e}},Gt=y.__private__.getPageInfo=y.getPageInfo=function(e){if(isNaN(e)||e%1!=0)throw new Error("Invalid argument passed to jsPDF.getPageInfo");return{objId:Pe[e].objId,pageNumber:e,pageContext:Pe[e]}},Xt=y.__private__.getPageInfoByObjId=function(e){if(isNaN(e)||e%1!=0)throw new Error("Invalid argument passed to jsPDF.getPageInfoByObjId");for(var t in Pe)if(Pe[t].objId===e)break;return Gt(t)},Wt=y.__private__.getCurrentPageInfo=y.getCurrentPageInfo=function(){return{objId:Pe[J].objId,pageNumber:J,pageContext:Pe[J]}};y.addPage=function(){return Ut.apply(this,arguments),this},y.setPage=function(){return Lt.apply(this,arguments),Ae.call(this,oe[J]),this},y.insertPage=function(e){return this.addPage(),this.movePage(J,e),this},y.movePage=function(e,t){var r,n;if(e>t){r=oe[e],n=Pe[e];for(var o=e;o>t;o--)oe[o]=oe[o-1],Pe[o]=Pe[o-1];oe[t]=r,Pe[t]=n,this.setPage(t)}else if(e<t){r=oe[e],n=Pe[e];for(var s=e;s<t;s++)oe[s]=oe[s+1],Pe[s]=Pe[s+1];oe[t]=r,Pe[t]=n,this.setPage(t)}return this},y.deletePage=function(){return St.apply(this,arguments),this},y.__private__.text=y.text=function(e,t,r,n,o){var s,i,a,A,u,c,l,d,f=(n=n||{}).scope||this;if("number"==typeof e&&"number"==typeof t&&("string"==typeof r||Array.isArray(r))){var h=r;r=t,t=e,e=h}if(arguments[3]instanceof Ke==0?(a=arguments[4],A=arguments[5],"object"==typeof(l=arguments[3])&&null!==l||("string"==typeof a&&(A=a,a=null),"string"==typeof l&&(A=l,l=null),"number"==typeof l&&(a=l,l=null),n={flags:l,angle:a,align:A})):(S("The transform parameter of text() with a Matrix value"),d=o),isNaN(t)||isNaN(r)||null==e)throw new Error("Invalid arguments passed to jsPDF.text");if(0===e.length)return f;var p="",m=!1,y="number"==typeof n.lineHeightFactor?n.lineHeightFactor:ur,v=f.internal.scaleFactor;function w(e){return e=e.split("\t").join(Array(n.TabLen||9).join(" ")),Qt(e,l)}function b(e){for(var t,r=e.concat(),n=[],o=r.length;o--;)"string"==typeof(t=r.shift())?n.push(t):Array.isArray(e)&&(1===t.length||void 0===t[1]&&void 0===t[2])?n.push(t[0]):n.push([t[0],t[1],t[2]]);return n}function B(e,t){var r;if("string"==typeof e)r=t(e)[0];else if(Array.isArray(e)){for(var n,o,s=e.concat(),i=[],a=s.length;a--;)"string"==typeof(n=s.shift())?i.push(t(n)[0]):Array.isArray(n)&&"string"==typeof n[0]&&(o=t(n[0],n[1],n[2]),i.push([o[0],o[1],o[2]]));r=i}return r}var C=!1,x=!0;if("string"==typeof e)C=!0;else if(Array.isArray(e)){var E=e.concat();i=[];for(var Q,F=E.length;F--;)("string"!=typeof(Q=E.shift())||Array.isArray(Q)&&"string"!=typeof Q[0])&&(x=!1);C=x}if(!1===C)throw new Error('Type of text must be string or Array. "'+e+'" is not recognized.');"string"==typeof e&&(e=e.match(/[\r?\n]/)?e.split(/\r\n|\r|\n/g):[e]);var U=fe/f.internal.scaleFactor,L=U*(ur-1);switch(n.baseline){case"bottom":r-=L;break;case"top":r+=U-L;break;case"hanging":r+=U-2*L;break;case"middle":r+=U/2-L}if((c=n.maxWidth||0)>0&&("string"==typeof e?e=f.splitTextToSize(e,c):"[object Array]"===Object.prototype.toString.call(e)&&(e=e.reduce((function(e,t){return e.concat(f.splitTextToSize(t,c))}),[]))),s={text:e,x:t,y:r,options:n,mutex:{pdfEscape:Qt,activeFontKey:je,fonts:Ne,activeFontSize:fe}},Oe.publish("preProcessText",s),e=s.text,a=(n=s.options).angle,d instanceof Ke==0&&a&&"number"==typeof a){a*=Math.PI/180,0===n.rotationDirection&&(a=-a),_===j.ADVANCED&&(a=-a);var T=Math.cos(a),H=Math.sin(a);d=new Ke(T,H,-H,T,0,0)}else a&&a instanceof Ke&&(d=a);_!==j.ADVANCED||d||(d=Ve),void 0!==(u=n.charSpace||jr)&&(p+=N(k(u))+" Tc\n",this.setCharSpace(this.getCharSpace()||0)),n.lang;var I=-1,P=void 0!==n.renderingMode?n.renderingMode:n.stroke,O=f.internal.getCurrentPageInfo().pageContext;switch(P){case 0:case!1:case"fill":I=0;break;case 1:case!0:case"stroke":I=1;break;case 2:case"fillThenStroke":I=2;break;case 3:case"invisible":I=3;break;case 4:case"fillAndAddForClipping":I=4;break;case 5:case"strokeAndAddPathForClipping":I=5;break;case 6:case"fillThenStrokeAndAddToPathForClipping":I=6;break;case 7:case"addToPathForClipping":I=7}var R=void 0!==O.usedRenderingMode?O.usedRenderingMode:-1;-1!==I?p+=I+" Tr\n":-1!==R&&(p+="0 Tr\n"),-1!==I&&(O.usedRenderingMode=I),A=n.align||"left";var M,D=fe*y,K=f.internal.pageSize.getWidth(),z=Ne[je];u=n.charSpace||jr,c=n.maxWidth||0,l=Object.assign({autoencode:!0,noBOM:!0},n.flags);var V=[];if("[object Array]"===Object.prototype.toString.call(e)){var q;i=b(e),"left"!==A&&(M=i.map((function(e){return f.getStringUnitWidth(e,{font:z,charSpace:u,fontSize:fe,doKerning:!1})*fe/v})));var G,X=0;if("right"===A){t-=M[0],e=[],F=i.length;for(var W=0;W<F;W++)0===W?(G=pr(t),q=mr(r)):(G=k(X-M[W]),q=-D),e.push([i[W],G,q]),X=M[W]}else if("center"===A){t-=M[0]/2,e=[],F=i.length;for(var J=0;J<F;J++)0===J?(G=pr(t),q=mr(r)):(G=k((X-M[J])/2),q=-D),e.push([i[J],G,q]),X=M[J]}else if("left"===A){e=[],F=i.length;for(var Y=0;Y<F;Y++)e.push(i[Y])}else{if("justify"!==A)throw new Error('Unrecognized alignment option, use "left", "center", "right" or "justify".');e=[],F=i.length,c=0!==c?c:K;for(var Z=0;Z<F;Z++)q=0===Z?mr(r):-D,G=0===Z?pr(t):0,Z<F-1&&V.push(N(k((c-M[Z])/(i[Z].split(" ").length-1)))),e.push([i[Z],G,q])}}var $="boolean"==typeof n.R2L?n.R2L:me;!0===$&&(e=B(e,(function(e,t,r){return[e.split("").reverse().join(""),t,r]}))),s={text:e,x:t,y:r,options:n,mutex:{pdfEscape:Qt,activeFontKey:je,fonts:Ne,activeFontSize:fe}},Oe.publish("postProcessText",s),e=s.text,m=s.mutex.isHex||!1;var ee=Ne[je].encoding;"WinAnsiEncoding"!==ee&&"StandardEncoding"!==ee||(e=B(e,(function(e,t,r){return[w(e),t,r]}))),i=b(e),e=[];for(var te,re,ne,oe=0,se=1,ie=Array.isArray(i[0])?se:oe,ae="",Ae=function(e,t,r){var o="";return r instanceof Ke?(r="number"==typeof n.angle?ze(r,new Ke(1,0,0,1,e,t)):ze(new Ke(1,0,0,1,e,t),r),_===j.ADVANCED&&(r=ze(new Ke(1,0,0,-1,0,0),r)),o=r.join(" ")+" Tm\n"):o=N(e)+" "+N(t)+" Td\n",o},ce=0;ce<i.length;ce++){switch(ae="",ie){case se:ne=(m?"<":"(")+i[ce][0]+(m?">":")"),te=parseFloat(i[ce][1]),re=parseFloat(i[ce][2]);break;case oe:ne=(m?"<":"(")+i[ce]+(m?">":")"),te=pr(t),re=mr(r)}void 0!==V&&void 0!==V[ce]&&(ae=V[ce]+" Tw\n"),0===ce?e.push(ae+Ae(te,re,d)+ne):ie===oe?e.push(ae+ne):ie===se&&e.push(ae+Ae(te,re,d)+ne)}e=ie===oe?e.join(" Tj\nT* "):e.join(" Tj\n"),e+=" Tj\n";var le="BT\n/";return le+=je+" "+fe+" Tf\n",le+=N(fe*y)+" TL\n",le+=br+"\n",le+=p,le+=e,ue(le+="ET"),g[je]=!0,f};var Jt=y.__private__.clip=y.clip=function(e){return ue("evenodd"===e?"W*":"W"),this};y.clipEvenOdd=function(){return Jt("evenodd")},y.__private__.discardPath=y.discardPath=function(){return ue("n"),this};var Yt=y.__private__.isValidStyle=function(e){var t=!1;return-1!==[void 0,null,"S","D","F","DF","FD","f","f*","B","B*","n"].indexOf(e)&&(t=!0),t};y.__private__.setDefaultPathOperation=y.setDefaultPathOperation=function(e){return Yt(e)&&(h=e),this};var Zt=y.__private__.getStyle=y.getStyle=function(e){var t=h;switch(e){case"D":case"S":t="S";break;case"F":t="f";break;case"FD":case"DF":t="B";break;case"f":case"f*":case"B":case"B*":t=e}return t},$t=y.close=function(){return ue("h"),this};y.stroke=function(){return ue("S"),this},y.fill=function(e){return er("f",e),this},y.fillEvenOdd=function(e){return er("f*",e),this},y.fillStroke=function(e){return er("B",e),this},y.fillStrokeEvenOdd=function(e){return er("B*",e),this};var er=function(e,t){"object"==typeof t?nr(t,e):ue(e)},tr=function(e){null===e||_===j.ADVANCED&&void 0===e||(e=Zt(e),ue(e))};function rr(e,t,r,n,o){var s=new T(t||this.boundingBox,r||this.xStep,n||this.yStep,this.gState,o||this.matrix);s.stream=this.stream;var i=e+"$$"+this.cloneIndex+++"$$";return qe(i,s),s}var nr=function(e,t){var r=Se[e.key],n=Ue[r];if(n instanceof L)ue("q"),ue(or(t)),n.gState&&y.setGState(n.gState),ue(e.matrix.toString()+" cm"),ue("/"+r+" sh"),ue("Q");else if(n instanceof T){var o=new Ke(1,0,0,-1,0,Ir());e.matrix&&(o=o.multiply(e.matrix||Ve),r=rr.call(n,e.key,e.boundingBox,e.xStep,e.yStep,o).id),ue("q"),ue("/Pattern cs"),ue("/"+r+" scn"),n.gState&&y.setGState(n.gState),ue(t),ue("Q")}},or=function(e){switch(e){case"f":case"F":return"W n";case"f*":return"W* n";case"B":return"W S";case"B*":return"W* S";case"S":return"W S";case"n":return"W n"}},sr=y.moveTo=function(e,t){return ue(N(k(e))+" "+N(M(t))+" m"),this},ir=y.lineTo=function(e,t){return ue(N(k(e))+" "+N(M(t))+" l"),this},ar=y.curveTo=function(e,t,r,n,o,s){return ue([N(k(e)),N(M(t)),N(k(r)),N(M(n)),N(k(o)),N(M(s)),"c"].join(" ")),this};y.__private__.line=y.line=function(e,t,r,n,o){if(isNaN(e)||isNaN(t)||isNaN(r)||isNaN(n)||!Yt(o))throw new Error("Invalid arguments passed to jsPDF.line");return _===j.COMPAT?this.lines([[r-e,n-t]],e,t,[1,1],o||"S"):this.lines([[r-e,n-t]],e,t,[1,1]).stroke()},y.__private__.lines=y.lines=function(e,t,r,n,o,s){var i,a,A,u,c,l,d,f,h,p,m,g;if("number"==typeof e&&(g=r,r=t,t=e,e=g),n=n||[1,1],s=s||!1,isNaN(t)||isNaN(r)||!Array.isArray(e)||!Array.isArray(n)||!Yt(o)||"boolean"!=typeof s)throw new Error("Invalid arguments passed to jsPDF.lines");for(sr(t,r),i=n[0],a=n[1],u=e.length,p=t,m=r,A=0;A<u;A++)2===(c=e[A]).length?(p=c[0]*i+p,m=c[1]*a+m,ir(p,m)):(l=c[0]*i+p,d=c[1]*a+m,f=c[2]*i+p,h=c[3]*a+m,p=c[4]*i+p,m=c[5]*a+m,ar(l,d,f,h,p,m));return s&&$t(),tr(o),this},y.path=function(e){for(var t=0;t<e.length;t++){var r=e[t],n=r.c;switch(r.op){case"m":sr(n[0],n[1]);break;case"l":ir(n[0],n[1]);break;case"c":ar.apply(this,n);break;case"h":$t()}}return this},y.__private__.rect=y.rect=function(e,t,r,n,o){if(isNaN(e)||isNaN(t)||isNaN(r)||isNaN(n)||!Yt(o))throw new Error("Invalid arguments passed to jsPDF.rect");return _===j.COMPAT&&(n=-n),ue([N(k(e)),N(M(t)),N(k(r)),N(k(n)),"re"].join(" ")),tr(o),this},y.__private__.triangle=y.triangle=function(e,t,r,n,o,s,i){if(isNaN(e)||isNaN(t)||isNaN(r)||isNaN(n)||isNaN(o)||isNaN(s)||!Yt(i))throw new Error("Invalid arguments passed to jsPDF.triangle");return this.lines([[r-e,n-t],[o-r,s-n],[e-o,t-s]],e,t,[1,1],i,!0),this},y.__private__.roundedRect=y.roundedRect=function(e,t,r,n,o,s,i){if(isNaN(e)||isNaN(t)||isNaN(r)||isNaN(n)||isNaN(o)||isNaN(s)||!Yt(i))throw new Error("Invalid arguments passed to jsPDF.roundedRect");var a=4/3*(Math.SQRT2-1);return o=Math.min(o,.5*r),s=Math.min(s,.5*n),this.lines([[r-2*o,0],[o*a,0,o,s-s*a,o,s],[0,n-2*s],[0,s*a,-o*a,s,-o,s],[2*o-r,0],[-o*a,0,-o,-s*a,-o,-s],[0,2*s-n],[0,-s*a,o*a,-s,o,-s]],e+o,t,[1,1],i,!0),this},y.__private__.ellipse=y.ellipse=function(e,t,r,n,o){if(isNaN(e)||isNaN(t)||isNaN(r)||isNaN(n)||!Yt(o))throw new Error("Invalid arguments passed to jsPDF.ellipse");var s=4/3*(Math.SQRT2-1)*r,i=4/3*(Math.SQRT2-1)*n;return sr(e+r,t),ar(e+r,t-i,e+s,t-n,e,t-n),ar(e-s,t-n,e-r,t-i,e-r,t),ar(e-r,t+i,e-s,t+n,e,t+n),ar(e+s,t+n,e+r,t+i,e+r,t),tr(o),this},y.__private__.circle=y.circle=function(e,t,r,n){if(isNaN(e)||isNaN(t)||isNaN(r)||!Yt(n))throw new Error("Invalid arguments passed to jsPDF.circle");return this.ellipse(e,t,r,r,n)},y.setFont=function(e,t,r){return r&&(t=E(t,r)),je=Ht(e,t,{disableWarning:!1}),this};var Ar=y.__private__.getFont=y.getFont=function(){return Ne[Ht.apply(y,arguments)]};y.__private__.getFontList=y.getFontList=function(){var e,t,r={};for(e in Qe)if(Qe.hasOwnProperty(e))for(t in r[e]=[],Qe[e])Qe[e].hasOwnProperty(t)&&r[e].push(t);return r},y.addFont=function(e,t,r,n,o){var s=["StandardEncoding","MacRomanEncoding","Identity-H","WinAnsiEncoding"];return arguments[3]&&-1!==s.indexOf(arguments[3])?o=arguments[3]:arguments[3]&&-1==s.indexOf(arguments[3])&&(r=E(r,n)),o=o||"Identity-H",Ct.call(this,e,t,r,o)};var ur,cr=e.lineWidth||.200025,lr=y.__private__.setLineWidth=y.setLineWidth=function(e){return ue(N(k(e))+" w"),this};y.__private__.setLineDash=H.API.setLineDash=H.API.setLineDashPattern=function(e,t){if(e=e||[],t=t||0,isNaN(t)||!Array.isArray(e))throw new Error("Invalid arguments passed to jsPDF.setLineDash");return e=e.map((function(e){return N(k(e))})).join(" "),t=N(k(t)),ue("["+e+"] "+t+" d"),this};var dr=y.__private__.getLineHeight=y.getLineHeight=function(){return fe*ur};y.__private__.getLineHeight=y.getLineHeight=function(){return fe*ur};var fr=y.__private__.setLineHeightFactor=y.setLineHeightFactor=function(e){return"number"==typeof(e=e||1.15)&&(ur=e),this},hr=y.__private__.getLineHeightFactor=y.getLineHeightFactor=function(){return ur};fr(e.lineHeight);var pr=y.__private__.getHorizontalCoordinate=function(e){return k(e)},mr=y.__private__.getVerticalCoordinate=function(e){return _===j.ADVANCED?e:Pe[J].mediaBox.topRightY-Pe[J].mediaBox.bottomLeftY-k(e)},gr=y.__private__.getHorizontalCoordinateString=y.getHorizontalCoordinateString=function(e){return N(pr(e))},yr=y.__private__.getVerticalCoordinateString=y.getVerticalCoordinateString=function(e){return N(mr(e))},vr=e.strokeColor||"0 G";y.__private__.getStrokeColor=y.getDrawColor=function(){return $e(vr)},y.__private__.setStrokeColor=y.setDrawColor=function(e,t,r,n){return vr=et({ch1:e,ch2:t,ch3:r,ch4:n,pdfColorType:"draw",precision:2}),ue(vr),this};var wr=e.fillColor||"0 g";y.__private__.getFillColor=y.getFillColor=function(){return $e(wr)},y.__private__.setFillColor=y.setFillColor=function(e,t,r,n){return wr=et({ch1:e,ch2:t,ch3:r,ch4:n,pdfColorType:"fill",precision:2}),ue(wr),this};var br=e.textColor||"0 g",Br=y.__private__.getTextColor=y.getTextColor=function(){return $e(br)};y.__private__.setTextColor=y.setTextColor=function(e,t,r,n){return br=et({ch1:e,ch2:t,ch3:r,ch4:n,pdfColorType:"text",precision:3}),this};var jr=e.charSpace,_r=y.__private__.getCharSpace=y.getCharSpace=function(){return parseFloat(jr||0)};y.__private__.setCharSpace=y.setCharSpace=function(e){if(isNaN(e))throw new Error("Invalid argument passed to jsPDF.setCharSpace");return jr=e,this};var Cr=0;y.CapJoinStyles={0:0,butt:0,but:0,miter:0,1:1,round:1,rounded:1,circle:1,2:2,projecting:2,project:2,square:2,bevel:2},y.__private__.setLineCap=y.setLineCap=function(e){var t=y.CapJoinStyles[e];if(void 0===t)throw new Error("Line cap style of '"+e+"' is not recognized. See or extend .CapJoinStyles property for valid styles");return Cr=t,ue(t+" J"),this};var xr=0;y.__private__.setLineJoin=y.setLineJoin=function(e){var t=y.CapJoinStyles[e];if(void 0===t)throw new Error("Line join style of '"+e+"' is not recognized. See or extend .CapJoinStyles property for valid styles");return xr=t,ue(t+" j"),this},y.__private__.setLineMiterLimit=y.__private__.setMiterLimit=y.setLineMiterLimit=y.setMiterLimit=function(e){if(e=e||0,isNaN(e))throw new Error("Invalid argument passed to jsPDF.setLineMiterLimit");return ue(N(k(e))+" M"),this},y.GState=U,y.setGState=function(e){(e="string"==typeof e?Le[Te[e]]:Er(null,e)).equals(He)||(ue("/"+e.id+" gs"),He=e)};var Er=function(e,t){if(!e||!Te[e]){var r=!1;for(var n in Le)if(Le.hasOwnProperty(n)&&Le[n].equals(t)){r=!0;break}if(r)t=Le[n];else{var o="GS"+(Object.keys(Le).length+1).toString(10);Le[o]=t,t.id=o}return e&&(Te[e]=t.id),Oe.publish("addGState",t),t}};y.addGState=function(e,t){return Er(e,t),this},y.saveGraphicsState=function(){return ue("q"),Fe.push({key:je,size:fe,color:br}),this},y.restoreGraphicsState=function(){ue("Q");var e=Fe.pop();return je=e.key,fe=e.size,br=e.color,He=null,this},y.setCurrentTransformationMatrix=function(e){return ue(e.toString()+" cm"),this},y.comment=function(e){return ue("#"+e),this};var Nr=function(e,t){var r=e||0;Object.defineProperty(this,"x",{enumerable:!0,get:function(){return r},set:function(e){isNaN(e)||(r=parseFloat(e))}});var n=t||0;Object.defineProperty(this,"y",{enumerable:!0,get:function(){return n},set:function(e){isNaN(e)||(n=parseFloat(e))}});var o="pt";return Object.defineProperty(this,"type",{enumerable:!0,get:function(){return o},set:function(e){o=e.toString()}}),this},Qr=function(e,t,r,n){Nr.call(this,e,t),this.type="rect";var o=r||0;Object.defineProperty(this,"w",{enumerable:!0,get:function(){return o},set:function(e){isNaN(e)||(o=parseFloat(e))}});var s=n||0;return Object.defineProperty(this,"h",{enumerable:!0,get:function(){return s},set:function(e){isNaN(e)||(s=parseFloat(e))}}),this},Fr=function(){this.page=Ie,this.currentPage=J,this.pages=oe.slice(0),this.pagesContext=Pe.slice(0),this.x=Ce,this.y=xe,this.matrix=Ee,this.width=Tr(J),this.height=Ir(J),this.outputDestination=ie,this.id="",this.objectNumber=-1};Fr.prototype.restore=function(){Ie=this.page,J=this.currentPage,Pe=this.pagesContext,oe=this.pages,Ce=this.x,xe=this.y,Ee=this.matrix,Hr(J,this.width),Pr(J,this.height),ie=this.outputDestination};var Ur=function(e,t,r,n,o){De.push(new Fr),Ie=J=0,oe=[],Ce=e,xe=t,Ee=o,Ft([r,n])},Sr=function(e){if(!Me[e]){var t=new Fr,r="Xo"+(Object.keys(Re).length+1).toString(10);t.id=r,Me[e]=r,Re[r]=t,Oe.publish("addFormObject",t),De.pop().restore()}};for(var Lr in y.beginFormObject=function(e,t,r,n,o){return Ur(e,t,r,n,o),this},y.endFormObject=function(e){return Sr(e),this},y.doFormObject=function(e,t){var r=Re[Me[e]];return ue("q"),ue(t.toString()+" cm"),ue("/"+r.id+" Do"),ue("Q"),this},y.getFormObject=function(e){var t=Re[Me[e]];return{x:t.x,y:t.y,width:t.width,height:t.height,matrix:t.matrix}},y.save=function(e,t){return e=e||"generated.pdf",(t=t||{}).returnPromise=t.returnPromise||!1,!1===t.returnPromise?(d(Dt(Mt()),e),"function"==typeof d.unload&&o.setTimeout&&setTimeout(d.unload,911),this):new Promise((function(t,r){try{var n=d(Dt(Mt()),e);"function"==typeof d.unload&&o.setTimeout&&setTimeout(d.unload,911),t(n)}catch(e){r(e.message)}}))},H.API)H.API.hasOwnProperty(Lr)&&("events"===Lr&&H.API.events.length?function(e,t){var r,n,o;for(o=t.length-1;-1!==o;o--)r=t[o][0],n=t[o][1],e.subscribe.apply(e,[r].concat("function"==typeof n?[n]:n))}(Oe,H.API.events):y[Lr]=H.API[Lr]);var Tr=y.getPageWidth=function(e){return(Pe[e=e||J].mediaBox.topRightX-Pe[e].mediaBox.bottomLeftX)/_e},Hr=y.setPageWidth=function(e,t){Pe[e].mediaBox.topRightX=t*_e+Pe[e].mediaBox.bottomLeftX},Ir=y.getPageHeight=function(e){return(Pe[e=e||J].mediaBox.topRightY-Pe[e].mediaBox.bottomLeftY)/_e},Pr=y.setPageHeight=function(e,t){Pe[e].mediaBox.topRightY=t*_e+Pe[e].mediaBox.bottomLeftY};return y.internal={pdfEscape:Qt,getStyle:Zt,getFont:Ar,getFontSize:pe,getCharSpace:_r,getTextColor:Br,getLineHeight:dr,getLineHeightFactor:hr,write:ce,getHorizontalCoordinate:pr,getVerticalCoordinate:mr,getCoordinateString:gr,getVerticalCoordinateString:yr,collections:{},newObject:Ge,newAdditionalObject:Je,newObjectDeferred:Xe,newObjectDeferredBegin:We,getFilters:tt,putStream:rt,events:Oe,scaleFactor:_e,pageSize:{getWidth:function(){return Tr(J)},setWidth:function(e){Hr(J,e)},getHeight:function(){return Ir(J)},setHeight:function(e){Pr(J,e)}},encryptionOptions:p,encryption:Vt,getEncryptor:qt,output:Kt,getNumberOfPages:Tt,pages:oe,out:ue,f2:P,f3:O,getPageInfo:Gt,getPageInfoByObjId:Xt,getCurrentPageInfo:Wt,getPDFVersion:w,Point:Nr,Rectangle:Qr,Matrix:Ke,hasHotfix:zt},Object.defineProperty(y.internal.pageSize,"width",{get:function(){return Tr(J)},set:function(e){Hr(J,e)},enumerable:!0,configurable:!0}),Object.defineProperty(y.internal.pageSize,"height",{get:function(){return Ir(J)},set:function(e){Pr(J,e)},enumerable:!0,configurable:!0}),xt.call(y,de),je="F1",Ut(s,r),Oe.publish("initialized"),y}Q.prototype.lsbFirstWord=function(e){return String.fromCharCode(e>>0&255,e>>8&255,e>>16&255,e>>24&255)},Q.prototype.toHexString=function(e){return e.split("").map((function(e){return("0"+(255&e.charCodeAt(0)).toString(16)).slice(-2)})).join("")},Q.prototype.hexToBytes=function(e){for(var t=[],r=0;r<e.length;r+=2)t.push(String.fromCharCode(parseInt(e.substr(r,2),16)));return t.join("")},Q.prototype.processOwnerPassword=function(e,t){return E(C(t).substr(0,5),e)},Q.prototype.encryptor=function(e,t){let r=C(this.encryptionKey+String.fromCharCode(255&e,e>>8&255,e>>16&255,255&t,t>>8&255)).substr(0,10);return function(e){return E(r,e)}},U.prototype.equals=function(e){var t,r="id,objectNumber,equals";if(!e||typeof e!=typeof this)return!1;var n=0;for(t in this)if(!(r.indexOf(t)>=0)){if(this.hasOwnProperty(t)&&!e.hasOwnProperty(t))return!1;if(this[t]!==e[t])return!1;n++}for(t in e)e.hasOwnProperty(t)&&r.indexOf(t)<0&&n--;return 0===n},H.API={events:[]},H.version="2.3.1";var I=H.API,P=1,O=function(e){return e.replace(/\\/g,"\\\\").replace(/\(/g,"\\(").replace(/\)/g,"\\)")},k=function(e){return e.replace(/\\\\/g,"\\").replace(/\\\(/g,"(").replace(/\\\)/g,")")},R=function(e){return e.toFixed(2)},M=function(e){return e.toFixed(5)};I.__acroform__={};var D=function(e,t){e.prototype=Object.create(t.prototype),e.prototype.constructor=e},K=function(e){return e*P},z=function(e){var t=new ie,r=we.internal.getHeight(e)||0,n=we.internal.getWidth(e)||0;return t.BBox=[0,0,Number(R(n)),Number(R(r))],t},V=I.__acroform__.setBit=function(e,t){if(e=e||0,t=t||0,isNaN(e)||isNaN(t))throw new Error("Invalid arguments passed to jsPDF.API.__acroform__.setBit");return e|1<<t},q=I.__acroform__.clearBit=function(e,t){if(e=e||0,t=t||0,isNaN(e)||isNaN(t))throw new Error("Invalid arguments passed to jsPDF.API.__acroform__.clearBit");return e&~(1<<t)},G=I.__acroform__.getBit=function(e,t){if(isNaN(e)||isNaN(t))throw new Error("Invalid arguments passed to jsPDF.API.__acroform__.getBit");return 0==(e&1<<t)?0:1},X=I.__acroform__.getBitForPdf=function(e,t){if(isNaN(e)||isNaN(t))throw new Error("Invalid arguments passed to jsPDF.API.__acroform__.getBitForPdf");return G(e,t-1)},W=I.__acroform__.setBitForPdf=function(e,t){if(isNaN(e)||isNaN(t))throw new Error("Invalid arguments passed to jsPDF.API.__acroform__.setBitForPdf");return V(e,t-1)},J=I.__acroform__.clearBitForPdf=function(e,t){if(isNaN(e)||isNaN(t))throw new Error("Invalid arguments passed to jsPDF.API.__acroform__.clearBitForPdf");return q(e,t-1)},Y=I.__acroform__.calculateCoordinates=function(e,t){var r=t.internal.getHorizontalCoordinate,n=t.internal.getVerticalCoordinate,o=e[0],s=e[1],i=e[2],a=e[3],A={};return A.lowerLeft_X=r(o)||0,A.lowerLeft_Y=n(s+a)||0,A.upperRight_X=r(o+i)||0,A.upperRight_Y=n(s)||0,[Number(R(A.lowerLeft_X)),Number(R(A.lowerLeft_Y)),Number(R(A.upperRight_X)),Number(R(A.upperRight_Y))]},Z=function(e){if(e.appearanceStreamContent)return e.appearanceStreamContent;if(e.V||e.DV){var t=[],r=e._V||e.DV,n=$(e,r),o=e.scope.internal.getFont(e.fontName,e.fontStyle).id;t.push("/Tx BMC"),t.push("q"),t.push("BT"),t.push(e.scope.__private__.encodeColorString(e.color)),t.push("/"+o+" "+R(n.fontSize)+" Tf"),t.push("1 0 0 1 0 0 Tm"),t.push(n.text),t.push("ET"),t.push("Q"),t.push("EMC");var s=z(e);return s.scope=e.scope,s.stream=t.join("\n"),s}},$=function(e,t){var r=0===e.fontSize?e.maxFontSize:e.fontSize,n={text:"",fontSize:""},o=(t=")"==(t="("==t.substr(0,1)?t.substr(1):t).substr(t.length-1)?t.substr(0,t.length-1):t).split(" "),s=r,i=we.internal.getHeight(e)||0;i=i<0?-i:i;var a=we.internal.getWidth(e)||0;a=a<0?-a:a;var A=function(t,r,n){if(t+1<o.length){var s=r+" "+o[t+1];return ee(s,e,n).width<=a-4}return!1};s++;e:for(;s>0;){t="",s--;var u,c,l=ee("3",e,s).height,d=e.multiline?i-s:(i-l)/2,f=d+=2,h=0,p=0;if(s<=0){t="(...) Tj\n",t+="% Width of Text: "+ee(t,e,s=12).width+", FieldWidth:"+a+"\n";break}var m="",g=0;for(var y in o)if(o.hasOwnProperty(y)){m=" "==(m+=o[y]+" ").substr(m.length-1)?m.substr(0,m.length-1):m;var v=parseInt(y),w=A(v,m,s),b=y>=o.length-1;if(w&&!b){m+=" ";continue}if(w||b){if(b)p=v;else if(e.multiline&&(l+2)*(g+2)+2>i)continue e}else{if(!e.multiline)continue e;if((l+2)*(g+2)+2>i)continue e;p=v}for(var B="",j=h;j<=p;j++)B+=o[j]+" ";switch(B=" "==B.substr(B.length-1)?B.substr(0,B.length-1):B,c=ee(B,e,s).width,e.textAlign){case"right":u=a-c-2;break;case"center":u=(a-c)/2;break;case"left":default:u=2}t+=R(u)+" "+R(f)+" Td\n",t+="("+O(B)+") Tj\n",t+=-R(u)+" 0 Td\n",f=-(s+2),c=0,h=p+1,g++,m=""}break}return n.text=t,n.fontSize=s,n},ee=function(e,t,r){var n=t.scope.internal.getFont(t.fontName,t.fontStyle),o=t.scope.getStringUnitWidth(e,{font:n,fontSize:parseFloat(r),charSpace:0})*parseFloat(r);return{height:t.scope.getStringUnitWidth("3",{font:n,fontSize:parseFloat(r),charSpace:0})*parseFloat(r)*1.5,width:o}},te={fields:[],xForms:[],acroFormDictionaryRoot:null,printedOut:!1,internal:null,isInitialized:!1},re=function(e,t){var r={type:"reference",object:e};void 0===t.internal.getPageInfo(e.page).pageContext.annotations.find((function(e){return e.type===r.type&&e.object===r.object}))&&t.internal.getPageInfo(e.page).pageContext.annotations.push(r)},ne=I.__acroform__.arrayToPdfArray=function(e,t,r){var n=function(e){return e};if(Array.isArray(e)){for(var o="[",s=0;s<e.length;s++)switch(0!==s&&(o+=" "),typeof e[s]){case"boolean":case"number":case"object":o+=e[s].toString();break;case"string":"/"!==e[s].substr(0,1)?(void 0!==t&&r&&(n=r.internal.getEncryptor(t)),o+="("+O(n(e[s].toString()))+")"):o+=e[s].toString()}return o+"]"}throw new Error("Invalid argument passed to jsPDF.__acroform__.arrayToPdfArray")},oe=function(e,t,r){var n=function(e){return e};return void 0!==t&&r&&(n=r.internal.getEncryptor(t)),(e=e||"").toString(),"("+O(n(e))+")"},se=function(){this._objId=void 0,this._scope=void 0,Object.defineProperty(this,"objId",{get:function(){if(void 0===this._objId){if(void 0===this.scope)return;this._objId=this.scope.internal.newObjectDeferred()}return this._objId},set:function(e){this._objId=e}}),Object.defineProperty(this,"scope",{value:this._scope,writable:!0})};se.prototype.toString=function(){return this.objId+" 0 R"},se.prototype.putStream=function(){var e=this.getKeyValueListForStream();this.scope.internal.putStream({data:this.stream,additionalKeyValues:e,objectId:this.objId}),this.scope.internal.out("endobj")},se.prototype.getKeyValueListForStream=function(){var e=[],t=Object.getOwnPropertyNames(this).filter((function(e){return"content"!=e&&"appearanceStreamContent"!=e&&"scope"!=e&&"objId"!=e&&"_"!=e.substring(0,1)}));for(var r in t)if(!1===Object.getOwnPropertyDescriptor(this,t[r]).configurable){var n=t[r],o=this[n];o&&(Array.isArray(o)?e.push({key:n,value:ne(o,this.objId,this.scope)}):o instanceof se?(o.scope=this.scope,e.push({key:n,value:o.objId+" 0 R"})):"function"!=typeof o&&e.push({key:n,value:o}))}return e};var ie=function(){se.call(this),Object.defineProperty(this,"Type",{value:"/XObject",configurable:!1,writable:!0}),Object.defineProperty(this,"Subtype",{value:"/Form",configurable:!1,writable:!0}),Object.defineProperty(this,"FormType",{value:1,configurable:!1,writable:!0});var e,t=[];Object.defineProperty(this,"BBox",{configurable:!1,get:function(){return t},set:function(e){t=e}}),Object.defineProperty(this,"Resources",{value:"2 0 R",configurable:!1,writable:!0}),Object.defineProperty(this,"stream",{enumerable:!1,configurable:!0,set:function(t){e=t.trim()},get:function(){return e||null}})};D(ie,se);var ae=function(){se.call(this);var e,t=[];Object.defineProperty(this,"Kids",{enumerable:!1,configurable:!0,get:function(){return t.length>0?t:void 0}}),Object.defineProperty(this,"Fields",{enumerable:!1,configurable:!1,get:function(){return t}}),Object.defineProperty(this,"DA",{enumerable:!1,configurable:!1,get:function(){if(e){var t=function(e){return e};return this.scope&&(t=this.scope.internal.getEncryptor(this.objId)),"("+O(t(e))+")"}},set:function(t){e=t}})};D(ae,se);var Ae=function(){se.call(this);var e=4;Object.defineProperty(this,"F",{enumerable:!1,configurable:!1,get:function(){return e},set:function(t){if(isNaN(t))throw new Error('Invalid value "'+t+'" for attribute F supplied.');e=t}}),Object.defineProperty(this,"showWhenPrinted",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(e,3))},set:function(t){!0===Boolean(t)?this.F=W(e,3):this.F=J(e,3)}});var t=0;Object.defineProperty(this,"Ff",{enumerable:!1,configurable:!1,get:function(){return t},set:function(e){if(isNaN(e))throw new Error('Invalid value "'+e+'" for attribute Ff supplied.');t=e}});var r=[];Object.defineProperty(this,"Rect",{enumerable:!1,configurable:!1,get:function(){if(0!==r.length)return r},set:function(e){r=void 0!==e?e:[]}}),Object.defineProperty(this,"x",{enumerable:!0,configurable:!0,get:function(){return!r||isNaN(r[0])?0:r[0]},set:function(e){r[0]=e}}),Object.defineProperty(this,"y",{enumerable:!0,configurable:!0,get:function(){return!r||isNaN(r[1])?0:r[1]},set:function(e){r[1]=e}}),Object.defineProperty(this,"width",{enumerable:!0,configurable:!0,get:function(){return!r||isNaN(r[2])?0:r[2]},set:function(e){r[2]=e}}),Object.defineProperty(this,"height",{enumerable:!0,configurable:!0,get:function(){return!r||isNaN(r[3])?0:r[3]},set:function(e){r[3]=e}});var n="";Object.defineProperty(this,"FT",{enumerable:!0,configurable:!1,get:function(){return n},set:function(e){switch(e){case"/Btn":case"/Tx":case"/Ch":case"/Sig":n=e;break;default:throw new Error('Invalid value "'+e+'" for attribute FT supplied.')}}});var o=null;Object.defineProperty(this,"T",{enumerable:!0,configurable:!1,get:function(){if(!o||o.length<1){if(this instanceof me)return;o="FieldObject"+Ae.FieldNum++}var e=function(e){return e};return this.scope&&(e=this.scope.internal.getEncryptor(this.objId)),"("+O(e(o))+")"},set:function(e){o=e.toString()}}),Object.defineProperty(this,"fieldName",{configurable:!0,enumerable:!0,get:function(){return o},set:function(e){o=e}});var s="helvetica";Object.defineProperty(this,"fontName",{enumerable:!0,configurable:!0,get:function(){return s},set:function(e){s=e}});var i="normal";Object.defineProperty(this,"fontStyle",{enumerable:!0,configurable:!0,get:function(){return i},set:function(e){i=e}});var a=0;Object.defineProperty(this,"fontSize",{enumerable:!0,configurable:!0,get:function(){return a},set:function(e){a=e}});var A=void 0;Object.defineProperty(this,"maxFontSize",{enumerable:!0,configurable:!0,get:function(){return void 0===A?50/P:A},set:function(e){A=e}});var u="black";Object.defineProperty(this,"color",{enumerable:!0,configurable:!0,get:function(){return u},set:function(e){u=e}});var c="/F1 0 Tf 0 g";Object.defineProperty(this,"DA",{enumerable:!0,configurable:!1,get:function(){if(!(!c||this instanceof me||this instanceof ye))return oe(c,this.objId,this.scope)},set:function(e){e=e.toString(),c=e}});var l=null;Object.defineProperty(this,"DV",{enumerable:!1,configurable:!1,get:function(){if(l)return this instanceof fe==0?oe(l,this.objId,this.scope):l},set:function(e){e=e.toString(),l=this instanceof fe==0?"("===e.substr(0,1)?k(e.substr(1,e.length-2)):k(e):e}}),Object.defineProperty(this,"defaultValue",{enumerable:!0,configurable:!0,get:function(){return this instanceof fe==1?k(l.substr(1,l.length-1)):l},set:function(e){e=e.toString(),l=this instanceof fe==1?"/"+e:e}});var d=null;Object.defineProperty(this,"_V",{enumerable:!1,configurable:!1,get:function(){if(d)return d},set:function(e){this.V=e}}),Object.defineProperty(this,"V",{enumerable:!1,configurable:!1,get:function(){if(d)return this instanceof fe==0?oe(d,this.objId,this.scope):d},set:function(e){e=e.toString(),d=this instanceof fe==0?"("===e.substr(0,1)?k(e.substr(1,e.length-2)):k(e):e}}),Object.defineProperty(this,"value",{enumerable:!0,configurable:!0,get:function(){return this instanceof fe==1?k(d.substr(1,d.length-1)):d},set:function(e){e=e.toString(),d=this instanceof fe==1?"/"+e:e}}),Object.defineProperty(this,"hasAnnotation",{enumerable:!0,configurable:!0,get:function(){return this.Rect}}),Object.defineProperty(this,"Type",{enumerable:!0,configurable:!1,get:function(){return this.hasAnnotation?"/Annot":null}}),Object.defineProperty(this,"Subtype",{enumerable:!0,configurable:!1,get:function(){return this.hasAnnotation?"/Widget":null}});var f,h=!1;Object.defineProperty(this,"hasAppearanceStream",{enumerable:!0,configurable:!0,get:function(){return h},set:function(e){e=Boolean(e),h=e}}),Object.defineProperty(this,"page",{enumerable:!0,configurable:!0,get:function(){if(f)return f},set:function(e){f=e}}),Object.defineProperty(this,"readOnly",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,1))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,1):this.Ff=J(this.Ff,1)}}),Object.defineProperty(this,"required",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,2))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,2):this.Ff=J(this.Ff,2)}}),Object.defineProperty(this,"noExport",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,3))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,3):this.Ff=J(this.Ff,3)}});var p=null;Object.defineProperty(this,"Q",{enumerable:!0,configurable:!1,get:function(){if(null!==p)return p},set:function(e){if(-1===[0,1,2].indexOf(e))throw new Error('Invalid value "'+e+'" for attribute Q supplied.');p=e}}),Object.defineProperty(this,"textAlign",{get:function(){var e;switch(p){case 0:default:e="left";break;case 1:e="center";break;case 2:e="right"}return e},configurable:!0,enumerable:!0,set:function(e){switch(e){case"right":case 2:p=2;break;case"center":case 1:p=1;break;case"left":case 0:default:p=0}}})};D(Ae,se);var ue=function(){Ae.call(this),this.FT="/Ch",this.V="()",this.fontName="zapfdingbats";var e=0;Object.defineProperty(this,"TI",{enumerable:!0,configurable:!1,get:function(){return e},set:function(t){e=t}}),Object.defineProperty(this,"topIndex",{enumerable:!0,configurable:!0,get:function(){return e},set:function(t){e=t}});var t=[];Object.defineProperty(this,"Opt",{enumerable:!0,configurable:!1,get:function(){return ne(t,this.objId,this.scope)},set:function(e){var r,n;n=[],"string"==typeof(r=e)&&(n=function(e,t,r){r||(r=1);for(var n,o=[];n=t.exec(e);)o.push(n[r]);return o}(r,/\((.*?)\)/g)),t=n}}),this.getOptions=function(){return t},this.setOptions=function(e){t=e,this.sort&&t.sort()},this.addOption=function(e){e=(e=e||"").toString(),t.push(e),this.sort&&t.sort()},this.removeOption=function(e,r){for(r=r||!1,e=(e=e||"").toString();-1!==t.indexOf(e)&&(t.splice(t.indexOf(e),1),!1!==r););},Object.defineProperty(this,"combo",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,18))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,18):this.Ff=J(this.Ff,18)}}),Object.defineProperty(this,"edit",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,19))},set:function(e){!0===this.combo&&(!0===Boolean(e)?this.Ff=W(this.Ff,19):this.Ff=J(this.Ff,19))}}),Object.defineProperty(this,"sort",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,20))},set:function(e){!0===Boolean(e)?(this.Ff=W(this.Ff,20),t.sort()):this.Ff=J(this.Ff,20)}}),Object.defineProperty(this,"multiSelect",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,22))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,22):this.Ff=J(this.Ff,22)}}),Object.defineProperty(this,"doNotSpellCheck",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,23))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,23):this.Ff=J(this.Ff,23)}}),Object.defineProperty(this,"commitOnSelChange",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,27))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,27):this.Ff=J(this.Ff,27)}}),this.hasAppearanceStream=!1};D(ue,Ae);var ce=function(){ue.call(this),this.fontName="helvetica",this.combo=!1};D(ce,ue);var le=function(){ce.call(this),this.combo=!0};D(le,ce);var de=function(){le.call(this),this.edit=!0};D(de,le);var fe=function(){Ae.call(this),this.FT="/Btn",Object.defineProperty(this,"noToggleToOff",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,15))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,15):this.Ff=J(this.Ff,15)}}),Object.defineProperty(this,"radio",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,16))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,16):this.Ff=J(this.Ff,16)}}),Object.defineProperty(this,"pushButton",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,17))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,17):this.Ff=J(this.Ff,17)}}),Object.defineProperty(this,"radioIsUnison",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,26))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,26):this.Ff=J(this.Ff,26)}});var e,t={};Object.defineProperty(this,"MK",{enumerable:!1,configurable:!1,get:function(){var e=function(e){return e};if(this.scope&&(e=this.scope.internal.getEncryptor(this.objId)),0!==Object.keys(t).length){var r,n=[];for(r in n.push("<<"),t)n.push("/"+r+" ("+O(e(t[r]))+")");return n.push(">>"),n.join("\n")}},set:function(e){"object"==typeof e&&(t=e)}}),Object.defineProperty(this,"caption",{enumerable:!0,configurable:!0,get:function(){return t.CA||""},set:function(e){"string"==typeof e&&(t.CA=e)}}),Object.defineProperty(this,"AS",{enumerable:!1,configurable:!1,get:function(){return e},set:function(t){e=t}}),Object.defineProperty(this,"appearanceState",{enumerable:!0,configurable:!0,get:function(){return e.substr(1,e.length-1)},set:function(t){e="/"+t}})};D(fe,Ae);var he=function(){fe.call(this),this.pushButton=!0};D(he,fe);var pe=function(){fe.call(this),this.radio=!0,this.pushButton=!1;var e=[];Object.defineProperty(this,"Kids",{enumerable:!0,configurable:!1,get:function(){return e},set:function(t){e=void 0!==t?t:[]}})};D(pe,fe);var me=function(){var e,t;Ae.call(this),Object.defineProperty(this,"Parent",{enumerable:!1,configurable:!1,get:function(){return e},set:function(t){e=t}}),Object.defineProperty(this,"optionName",{enumerable:!1,configurable:!0,get:function(){return t},set:function(e){t=e}});var r,n={};Object.defineProperty(this,"MK",{enumerable:!1,configurable:!1,get:function(){var e=function(e){return e};this.scope&&(e=this.scope.internal.getEncryptor(this.objId));var t,r=[];for(t in r.push("<<"),n)r.push("/"+t+" ("+O(e(n[t]))+")");return r.push(">>"),r.join("\n")},set:function(e){"object"==typeof e&&(n=e)}}),Object.defineProperty(this,"caption",{enumerable:!0,configurable:!0,get:function(){return n.CA||""},set:function(e){"string"==typeof e&&(n.CA=e)}}),Object.defineProperty(this,"AS",{enumerable:!1,configurable:!1,get:function(){return r},set:function(e){r=e}}),Object.defineProperty(this,"appearanceState",{enumerable:!0,configurable:!0,get:function(){return r.substr(1,r.length-1)},set:function(e){r="/"+e}}),this.caption="l",this.appearanceState="Off",this._AppearanceType=we.RadioButton.Circle,this.appearanceStreamContent=this._AppearanceType.createAppearanceStream(this.optionName)};D(me,Ae),pe.prototype.setAppearance=function(e){if(!("createAppearanceStream"in e)||!("getCA"in e))throw new Error("Couldn't assign Appearance to RadioButton. Appearance was Invalid!");for(var t in this.Kids)if(this.Kids.hasOwnProperty(t)){var r=this.Kids[t];r.appearanceStreamContent=e.createAppearanceStream(r.optionName),r.caption=e.getCA()}},pe.prototype.createOption=function(e){var t=new me;return t.Parent=this,t.optionName=e,this.Kids.push(t),be.call(this.scope,t),t};var ge=function(){fe.call(this),this.fontName="zapfdingbats",this.caption="3",this.appearanceState="On",this.value="On",this.textAlign="center",this.appearanceStreamContent=we.CheckBox.createAppearanceStream()};D(ge,fe);var ye=function(){Ae.call(this),this.FT="/Tx",Object.defineProperty(this,"multiline",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,13))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,13):this.Ff=J(this.Ff,13)}}),Object.defineProperty(this,"fileSelect",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,21))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,21):this.Ff=J(this.Ff,21)}}),Object.defineProperty(this,"doNotSpellCheck",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,23))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,23):this.Ff=J(this.Ff,23)}}),Object.defineProperty(this,"doNotScroll",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,24))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,24):this.Ff=J(this.Ff,24)}}),Object.defineProperty(this,"comb",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,25))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,25):this.Ff=J(this.Ff,25)}}),Object.defineProperty(this,"richText",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,26))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,26):this.Ff=J(this.Ff,26)}});var e=null;Object.defineProperty(this,"MaxLen",{enumerable:!0,configurable:!1,get:function(){return e},set:function(t){e=t}}),Object.defineProperty(this,"maxLength",{enumerable:!0,configurable:!0,get:function(){return e},set:function(t){Number.isInteger(t)&&(e=t)}}),Object.defineProperty(this,"hasAppearanceStream",{enumerable:!0,configurable:!0,get:function(){return this.V||this.DV}})};D(ye,Ae);var ve=function(){ye.call(this),Object.defineProperty(this,"password",{enumerable:!0,configurable:!0,get:function(){return Boolean(X(this.Ff,14))},set:function(e){!0===Boolean(e)?this.Ff=W(this.Ff,14):this.Ff=J(this.Ff,14)}}),this.password=!0};D(ve,ye);var we={CheckBox:{createAppearanceStream:function(){return{N:{On:we.CheckBox.YesNormal},D:{On:we.CheckBox.YesPushDown,Off:we.CheckBox.OffPushDown}}},YesPushDown:function(e){var t=z(e);t.scope=e.scope;var r=[],n=e.scope.internal.getFont(e.fontName,e.fontStyle).id,o=e.scope.__private__.encodeColorString(e.color),s=$(e,e.caption);return r.push("0.749023 g"),r.push("0 0 "+R(we.internal.getWidth(e))+" "+R(we.internal.getHeight(e))+" re"),r.push("f"),r.push("BMC"),r.push("q"),r.push("0 0 1 rg"),r.push("/"+n+" "+R(s.fontSize)+" Tf "+o),r.push("BT"),r.push(s.text),r.push("ET"),r.push("Q"),r.push("EMC"),t.stream=r.join("\n"),t},YesNormal:function(e){var t=z(e);t.scope=e.scope;var r=e.scope.internal.getFont(e.fontName,e.fontStyle).id,n=e.scope.__private__.encodeColorString(e.color),o=[],s=we.internal.getHeight(e),i=we.internal.getWidth(e),a=$(e,e.caption);return o.push("1 g"),o.push("0 0 "+R(i)+" "+R(s)+" re"),o.push("f"),o.push("q"),o.push("0 0 1 rg"),o.push("0 0 "+R(i-1)+" "+R(s-1)+" re"),o.push("W"),o.push("n"),o.push("0 g"),o.push("BT"),o.push("/"+r+" "+R(a.fontSize)+" Tf "+n),o.push(a.text),o.push("ET"),o.push("Q"),t.stream=o.join("\n"),t},OffPushDown:function(e){var t=z(e);t.scope=e.scope;var r=[];return r.push("0.749023 g"),r.push("0 0 "+R(we.internal.getWidth(e))+" "+R(we.internal.getHeight(e))+" re"),r.push("f"),t.stream=r.join("\n"),t}},RadioButton:{Circle:{createAppearanceStream:function(e){var t={D:{Off:we.RadioButton.Circle.OffPushDown},N:{}};return t.N[e]=we.RadioButton.Circle.YesNormal,t.D[e]=we.RadioButton.Circle.YesPushDown,t},getCA:function(){return"l"},YesNormal:function(e){var t=z(e);t.scope=e.scope;var r=[],n=we.internal.getWidth(e)<=we.internal.getHeight(e)?we.internal.getWidth(e)/4:we.internal.getHeight(e)/4;n=Number((.9*n).toFixed(5));var o=we.internal.Bezier_C,s=Number((n*o).toFixed(5));return r.push("q"),r.push("1 0 0 1 "+M(we.internal.getWidth(e)/2)+" "+M(we.internal.getHeight(e)/2)+" cm"),r.push(n+" 0 m"),r.push(n+" "+s+" "+s+" "+n+" 0 "+n+" c"),r.push("-"+s+" "+n+" -"+n+" "+s+" -"+n+" 0 c"),r.push("-"+n+" -"+s+" -"+s+" -"+n+" 0 -"+n+" c"),r.push(s+" -"+n+" "+n+" -"+s+" "+n+" 0 c"),r.push("f"),r.push("Q"),t.stream=r.join("\n"),t},YesPushDown:function(e){var t=z(e);t.scope=e.scope;var r=[],n=we.internal.getWidth(e)<=we.internal.getHeight(e)?we.internal.getWidth(e)/4:we.internal.getHeight(e)/4;n=Number((.9*n).toFixed(5));var o=Number((2*n).toFixed(5)),s=Number((o*we.internal.Bezier_C).toFixed(5)),i=Number((n*we.internal.Bezier_C).toFixed(5));return r.push("0.749023 g"),r.push("q"),r.push("1 0 0 1 "+M(we.internal.getWidth(e)/2)+" "+M(we.internal.getHeight(e)/2)+" cm"),r.push(o+" 0 m"),r.push(o+" "+s+" "+s+" "+o+" 0 "+o+" c"),r.push("-"+s+" "+o+" -"+o+" "+s+" -"+o+" 0 c"),r.push("-"+o+" -"+s+" -"+s+" -"+o+" 0 -"+o+" c"),r.push(s+" -"+o+" "+o+" -"+s+" "+o+" 0 c"),r.push("f"),r.push("Q"),r.push("0 g"),r.push("q"),r.push("1 0 0 1 "+M(we.internal.getWidth(e)/2)+" "+M(we.internal.getHeight(e)/2)+" cm"),r.push(n+" 0 m"),r.push(n+" "+i+" "+i+" "+n+" 0 "+n+" c"),r.push("-"+i+" "+n+" -"+n+" "+i+" -"+n+" 0 c"),r.push("-"+n+" -"+i+" -"+i+" -"+n+" 0 -"+n+" c"),r.push(i+" -"+n+" "+n+" -"+i+" "+n+" 0 c"),r.push("f"),r.push("Q"),t.stream=r.join("\n"),t},OffPushDown:function(e){var t=z(e);t.scope=e.scope;var r=[],n=we.internal.getWidth(e)<=we.internal.getHeight(e)?we.internal.getWidth(e)/4:we.internal.getHeight(e)/4;n=Number((.9*n).toFixed(5));var o=Number((2*n).toFixed(5)),s=Number((o*we.internal.Bezier_C).toFixed(5));return r.push("0.749023 g"),r.push("q"),r.push("1 0 0 1 "+M(we.internal.getWidth(e)/2)+" "+M(we.internal.getHeight(e)/2)+" cm"),r.push(o+" 0 m"),r.push(o+" "+s+" "+s+" "+o+" 0 "+o+" c"),r.push("-"+s+" "+o+" -"+o+" "+s+" -"+o+" 0 c"),r.push("-"+o+" -"+s+" -"+s+" -"+o+" 0 -"+o+" c"),r.push(s+" -"+o+" "+o+" -"+s+" "+o+" 0 c"),r.push("f"),r.push("Q"),t.stream=r.join("\n"),t}},Cross:{createAppearanceStream:function(e){var t={D:{Off:we.RadioButton.Cross.OffPushDown},N:{}};return t.N[e]=we.RadioButton.Cross.YesNormal,t.D[e]=we.RadioButton.Cross.YesPushDown,t},getCA:function(){return"8"},YesNormal:function(e){var t=z(e);t.scope=e.scope;var r=[],n=we.internal.calculateCross(e);return r.push("q"),r.push("1 1 "+R(we.internal.getWidth(e)-2)+" "+R(we.internal.getHeight(e)-2)+" re"),r.push("W"),r.push("n"),r.push(R(n.x1.x)+" "+R(n.x1.y)+" m"),r.push(R(n.x2.x)+" "+R(n.x2.y)+" l"),r.push(R(n.x4.x)+" "+R(n.x4.y)+" m"),r.push(R(n.x3.x)+" "+R(n.x3.y)+" l"),r.push("s"),r.push("Q"),t.stream=r.join("\n"),t},YesPushDown:function(e){var t=z(e);t.scope=e.scope;var r=we.internal.calculateCross(e),n=[];return n.push("0.749023 g"),n.push("0 0 "+R(we.internal.getWidth(e))+" "+R(we.internal.getHeight(e))+" re"),n.push("f"),n.push("q"),n.push("1 1 "+R(we.internal.getWidth(e)-2)+" "+R(we.internal.getHeight(e)-2)+" re"),n.push("W"),n.push("n"),n.push(R(r.x1.x)+" "+R(r.x1.y)+" m"),n.push(R(r.x2.x)+" "+R(r.x2.y)+" l"),n.push(R(r.x4.x)+" "+R(r.x4.y)+" m"),n.push(R(r.x3.x)+" "+R(r.x3.y)+" l"),n.push("s"),n.push("Q"),t.stream=n.join("\n"),t},OffPushDown:function(e){var t=z(e);t.scope=e.scope;var r=[];return r.push("0.749023 g"),r.push("0 0 "+R(we.internal.getWidth(e))+" "+R(we.internal.getHeight(e))+" re"),r.push("f"),t.stream=r.join("\n"),t}}},createDefaultAppearanceStream:function(e){var t=e.scope.internal.getFont(e.fontName,e.fontStyle).id,r=e.scope.__private__.encodeColorString(e.color);return"/"+t+" "+e.fontSize+" Tf "+r}};we.internal={Bezier_C:.551915024494,calculateCross:function(e){var t=we.internal.getWidth(e),r=we.internal.getHeight(e),n=Math.min(t,r);return{x1:{x:(t-n)/2,y:(r-n)/2+n},x2:{x:(t-n)/2+n,y:(r-n)/2},x3:{x:(t-n)/2,y:(r-n)/2},x4:{x:(t-n)/2+n,y:(r-n)/2+n}}}},we.internal.getWidth=function(e){var t=0;return"object"==typeof e&&(t=K(e.Rect[2])),t},we.internal.getHeight=function(e){var t=0;return"object"==typeof e&&(t=K(e.Rect[3])),t};var be=I.addField=function(e){if(function(e,t){if(t.scope=e,void 0!==e.internal&&(void 0===e.internal.acroformPlugin||!1===e.internal.acroformPlugin.isInitialized)){if(Ae.FieldNum=0,e.internal.acroformPlugin=JSON.parse(JSON.stringify(te)),e.internal.acroformPlugin.acroFormDictionaryRoot)throw new Error("Exception while creating AcroformDictionary");P=e.internal.scaleFactor,e.internal.acroformPlugin.acroFormDictionaryRoot=new ae,e.internal.acroformPlugin.acroFormDictionaryRoot.scope=e,e.internal.acroformPlugin.acroFormDictionaryRoot._eventID=e.internal.events.subscribe("postPutResources",(function(){!function(e){e.internal.events.unsubscribe(e.internal.acroformPlugin.acroFormDictionaryRoot._eventID),delete e.internal.acroformPlugin.acroFormDictionaryRoot._eventID,e.internal.acroformPlugin.printedOut=!0}(e)})),e.internal.events.subscribe("buildDocument",(function(){!function(e){e.internal.acroformPlugin.acroFormDictionaryRoot.objId=void 0;var t=e.internal.acroformPlugin.acroFormDictionaryRoot.Fields;for(var r in t)if(t.hasOwnProperty(r)){var n=t[r];n.objId=void 0,n.hasAnnotation&&re(n,e)}}(e)})),e.internal.events.subscribe("putCatalog",(function(){!function(e){if(void 0===e.internal.acroformPlugin.acroFormDictionaryRoot)throw new Error("putCatalogCallback: Root missing.");e.internal.write("/AcroForm "+e.internal.acroformPlugin.acroFormDictionaryRoot.objId+" 0 R")}(e)})),e.internal.events.subscribe("postPutPages",(function(t){!function(e,t){var r=!e;for(var n in e||(t.internal.newObjectDeferredBegin(t.internal.acroformPlugin.acroFormDictionaryRoot.objId,!0),t.internal.acroformPlugin.acroFormDictionaryRoot.putStream()),e=e||t.internal.acroformPlugin.acroFormDictionaryRoot.Kids)if(e.hasOwnProperty(n)){var o=e[n],s=[],i=o.Rect;if(o.Rect&&(o.Rect=Y(o.Rect,t)),t.internal.newObjectDeferredBegin(o.objId,!0),o.DA=we.createDefaultAppearanceStream(o),"object"==typeof o&&"function"==typeof o.getKeyValueListForStream&&(s=o.getKeyValueListForStream()),o.Rect=i,o.hasAppearanceStream&&!o.appearanceStreamContent){var a=Z(o);s.push({key:"AP",value:"<</N "+a+">>"}),t.internal.acroformPlugin.xForms.push(a)}if(o.appearanceStreamContent){var A="";for(var u in o.appearanceStreamContent)if(o.appearanceStreamContent.hasOwnProperty(u)){var c=o.appearanceStreamContent[u];if(A+="/"+u+" ",A+="<<",Object.keys(c).length>=1||Array.isArray(c)){for(var n in c)if(c.hasOwnProperty(n)){var l=c[n];"function"==typeof l&&(l=l.call(t,o)),A+="/"+n+" "+l+" ",t.internal.acroformPlugin.xForms.indexOf(l)>=0||t.internal.acroformPlugin.xForms.push(l)}}else"function"==typeof(l=c)&&(l=l.call(t,o)),A+="/"+n+" "+l,t.internal.acroformPlugin.xForms.indexOf(l)>=0||t.internal.acroformPlugin.xForms.push(l);A+=">>"}s.push({key:"AP",value:"<<\n"+A+">>"})}t.internal.putStream({additionalKeyValues:s,objectId:o.objId}),t.internal.out("endobj")}r&&function(e,t){for(var r in e)if(e.hasOwnProperty(r)){var n=r,o=e[r];t.internal.newObjectDeferredBegin(o.objId,!0),"object"==typeof o&&"function"==typeof o.putStream&&o.putStream(),delete e[n]}}(t.internal.acroformPlugin.xForms,t)}(t,e)})),e.internal.acroformPlugin.isInitialized=!0}}(this,e),!(e instanceof Ae))throw new Error("Invalid argument passed to jsPDF.addField.");var t;return(t=e).scope.internal.acroformPlugin.printedOut&&(t.scope.internal.acroformPlugin.printedOut=!1,t.scope.internal.acroformPlugin.acroFormDictionaryRoot=null),t.scope.internal.acroformPlugin.acroFormDictionaryRoot.Fields.push(t),e.page=e.scope.internal.getCurrentPageInfo().pageNumber,this};I.AcroFormChoiceField=ue,I.AcroFormListBox=ce,I.AcroFormComboBox=le,I.AcroFormEditBox=de,I.AcroFormButton=fe,I.AcroFormPushButton=he,I.AcroFormRadioButton=pe,I.AcroFormCheckBox=ge,I.AcroFormTextField=ye,I.AcroFormPasswordField=ve,I.AcroFormAppearance=we,I.AcroForm={ChoiceField:ue,ListBox:ce,ComboBox:le,EditBox:de,Button:fe,PushButton:he,RadioButton:pe,CheckBox:ge,TextField:ye,PasswordField:ve,Appearance:we},H.AcroForm={ChoiceField:ue,ListBox:ce,ComboBox:le,EditBox:de,Button:fe,PushButton:he,RadioButton:pe,CheckBox:ge,TextField:ye,PasswordField:ve,Appearance:we};var Be,je,_e=H.AcroForm;function Ce(e){return e.reduce((function(e,t,r){return e[t]=r,e}),{})}!function(e){e.__addimage__={};var t="UNKNOWN",r={PNG:[[137,80,78,71]],TIFF:[[77,77,0,42],[73,73,42,0]],JPEG:[[255,216,255,224,void 0,void 0,74,70,73,70,0],[255,216,255,225,void 0,void 0,69,120,105,102,0,0],[255,216,255,219],[255,216,255,238]],JPEG2000:[[0,0,0,12,106,80,32,32]],GIF87a:[[71,73,70,56,55,97]],GIF89a:[[71,73,70,56,57,97]],WEBP:[[82,73,70,70,void 0,void 0,void 0,void 0,87,69,66,80]],BMP:[[66,77],[66,65],[67,73],[67,80],[73,67],[80,84]]},n=e.__addimage__.getImageFileTypeByImageData=function(e,n){var o,s;n=n||t;var i,a,A,u=t;if(_(e))for(A in r)for(i=r[A],o=0;o<i.length;o+=1){for(a=!0,s=0;s<i[o].length;s+=1)if(void 0!==i[o][s]&&i[o][s]!==e[s]){a=!1;break}if(!0===a){u=A;break}}else for(A in r)for(i=r[A],o=0;o<i.length;o+=1){for(a=!0,s=0;s<i[o].length;s+=1)if(void 0!==i[o][s]&&i[o][s]!==e.charCodeAt(s)){a=!1;break}if(!0===a){u=A;break}}return u===t&&n!==t&&(u=n),u},o=function(e){for(var t=this.internal.write,r=this.internal.putStream,n=(0,this.internal.getFilters)();-1!==n.indexOf("FlateEncode");)n.splice(n.indexOf("FlateEncode"),1);e.objectId=this.internal.newObject();var s=[];if(s.push({key:"Type",value:"/XObject"}),s.push({key:"Subtype",value:"/Image"}),s.push({key:"Width",value:e.width}),s.push({key:"Height",value:e.height}),e.colorSpace===y.INDEXED?s.push({key:"ColorSpace",value:"[/Indexed /DeviceRGB "+(e.palette.length/3-1)+" "+("sMask"in e&&void 0!==e.sMask?e.objectId+2:e.objectId+1)+" 0 R]"}):(s.push({key:"ColorSpace",value:"/"+e.colorSpace}),e.colorSpace===y.DEVICE_CMYK&&s.push({key:"Decode",value:"[1 0 1 0 1 0 1 0]"})),s.push({key:"BitsPerComponent",value:e.bitsPerComponent}),"decodeParameters"in e&&void 0!==e.decodeParameters&&s.push({key:"DecodeParms",value:"<<"+e.decodeParameters+">>"}),"transparency"in e&&Array.isArray(e.transparency)){for(var i="",a=0,A=e.transparency.length;a<A;a++)i+=e.transparency[a]+" "+e.transparency[a]+" ";s.push({key:"Mask",value:"["+i+"]"})}void 0!==e.sMask&&s.push({key:"SMask",value:e.objectId+1+" 0 R"});var u=void 0!==e.filter?["/"+e.filter]:void 0;if(r({data:e.data,additionalKeyValues:s,alreadyAppliedFilters:u,objectId:e.objectId}),t("endobj"),"sMask"in e&&void 0!==e.sMask){var c="/Predictor "+e.predictor+" /Colors 1 /BitsPerComponent "+e.bitsPerComponent+" /Columns "+e.width,l={width:e.width,height:e.height,colorSpace:"DeviceGray",bitsPerComponent:e.bitsPerComponent,decodeParameters:c,data:e.sMask};"filter"in e&&(l.filter=e.filter),o.call(this,l)}if(e.colorSpace===y.INDEXED){var d=this.internal.newObject();r({data:x(new Uint8Array(e.palette)),objectId:d}),t("endobj")}},s=function(){var e=this.internal.collections.addImage_images;for(var t in e)o.call(this,e[t])},i=function(){var e,t=this.internal.collections.addImage_images,r=this.internal.write;for(var n in t)r("/I"+(e=t[n]).index,e.objectId,"0","R")},a=function(){this.internal.collections.addImage_images||(this.internal.collections.addImage_images={},this.internal.events.subscribe("putResources",s),this.internal.events.subscribe("putXobjectDict",i))},A=function(){var e=this.internal.collections.addImage_images;return a.call(this),e},u=function(){return Object.keys(this.internal.collections.addImage_images).length},d=function(t){return"function"==typeof e["process"+t.toUpperCase()]},f=function(e){return"object"==typeof e&&1===e.nodeType},h=function(t,r){if("IMG"===t.nodeName&&t.hasAttribute("src")){var n=""+t.getAttribute("src");if(0===n.indexOf("data:image/"))return c(unescape(n).split("base64,").pop());var o=e.loadFile(n,!0);if(void 0!==o)return o}if("CANVAS"===t.nodeName){var s;switch(r){case"PNG":s="image/png";break;case"WEBP":s="image/webp";break;case"JPEG":case"JPG":default:s="image/jpeg"}return c(t.toDataURL(s,1).split("base64,").pop())}},p=function(e){var t=this.internal.collections.addImage_images;if(t)for(var r in t)if(e===t[r].alias)return t[r]},m=function(e,t,r){return e||t||(e=-96,t=-96),e<0&&(e=-1*r.width*72/e/this.internal.scaleFactor),t<0&&(t=-1*r.height*72/t/this.internal.scaleFactor),0===e&&(e=t*r.width/r.height),0===t&&(t=e*r.height/r.width),[e,t]},g=function(e,t,r,n,o,s){var i=m.call(this,r,n,o),a=this.internal.getCoordinateString,u=this.internal.getVerticalCoordinateString,c=A.call(this);if(r=i[0],n=i[1],c[o.index]=o,s){s*=Math.PI/180;var l=Math.cos(s),d=Math.sin(s),f=function(e){return e.toFixed(4)},h=[f(l),f(d),f(-1*d),f(l),0,0,"cm"]}this.internal.write("q"),s?(this.internal.write([1,"0","0",1,a(e),u(t+n),"cm"].join(" ")),this.internal.write(h.join(" ")),this.internal.write([a(r),"0","0",a(n),"0","0","cm"].join(" "))):this.internal.write([a(r),"0","0",a(n),a(e),u(t+n),"cm"].join(" ")),this.isAdvancedAPI()&&this.internal.write([1,0,0,-1,0,0,"cm"].join(" ")),this.internal.write("/I"+o.index+" Do"),this.internal.write("Q")},y=e.color_spaces={DEVICE_RGB:"DeviceRGB",DEVICE_GRAY:"DeviceGray",DEVICE_CMYK:"DeviceCMYK",CAL_GREY:"CalGray",CAL_RGB:"CalRGB",LAB:"Lab",ICC_BASED:"ICCBased",INDEXED:"Indexed",PATTERN:"Pattern",SEPARATION:"Separation",DEVICE_N:"DeviceN"};e.decode={DCT_DECODE:"DCTDecode",FLATE_DECODE:"FlateDecode",LZW_DECODE:"LZWDecode",JPX_DECODE:"JPXDecode",JBIG2_DECODE:"JBIG2Decode",ASCII85_DECODE:"ASCII85Decode",ASCII_HEX_DECODE:"ASCIIHexDecode",RUN_LENGTH_DECODE:"RunLengthDecode",CCITT_FAX_DECODE:"CCITTFaxDecode"};var v=e.image_compression={NONE:"NONE",FAST:"FAST",MEDIUM:"MEDIUM",SLOW:"SLOW"},w=e.__addimage__.sHashCode=function(e){var t,r,n=0;if("string"==typeof e)for(r=e.length,t=0;t<r;t++)n=(n<<5)-n+e.charCodeAt(t),n|=0;else if(_(e))for(r=e.byteLength/2,t=0;t<r;t++)n=(n<<5)-n+e[t],n|=0;return n},b=e.__addimage__.validateStringAsBase64=function(e){(e=e||"").toString().trim();var t=!0;return 0===e.length&&(t=!1),e.length%4!=0&&(t=!1),!1===/^[A-Za-z0-9+/]+$/.test(e.substr(0,e.length-2))&&(t=!1),!1===/^[A-Za-z0-9/][A-Za-z0-9+/]|[A-Za-z0-9+/]=|==$/.test(e.substr(-2))&&(t=!1),t},B=e.__addimage__.extractImageFromDataUrl=function(e){var t=(e=e||"").split("base64,"),r=null;if(2===t.length){var n=/^data:(\w*\/\w*);*(charset=(?!charset=)[\w=-]*)*;*$/.exec(t[0]);Array.isArray(n)&&(r={mimeType:n[1],charset:n[2],data:t[1]})}return r},j=e.__addimage__.supportsArrayBuffer=function(){return"undefined"!=typeof ArrayBuffer&&"undefined"!=typeof Uint8Array};e.__addimage__.isArrayBuffer=function(e){return j()&&e instanceof ArrayBuffer};var _=e.__addimage__.isArrayBufferView=function(e){return j()&&"undefined"!=typeof Uint32Array&&(e instanceof Int8Array||e instanceof Uint8Array||"undefined"!=typeof Uint8ClampedArray&&e instanceof Uint8ClampedArray||e instanceof Int16Array||e instanceof Uint16Array||e instanceof Int32Array||e instanceof Uint32Array||e instanceof Float32Array||e instanceof Float64Array)},C=e.__addimage__.binaryStringToUint8Array=function(e){for(var t=e.length,r=new Uint8Array(t),n=0;n<t;n++)r[n]=e.charCodeAt(n);return r},x=e.__addimage__.arrayBufferToBinaryString=function(e){try{return c(l(String.fromCharCode.apply(null,e)))}catch(t){if("undefined"!=typeof Uint8Array&&void 0!==Uint8Array.prototype.reduce)return new Uint8Array(e).reduce((function(e,t){return e.push(String.fromCharCode(t)),e}),[]).join("")}};e.addImage=function(){var e,r,n,o,s,i,A,u,c;if("number"==typeof arguments[1]?(r=t,n=arguments[1],o=arguments[2],s=arguments[3],i=arguments[4],A=arguments[5],u=arguments[6],c=arguments[7]):(r=arguments[1],n=arguments[2],o=arguments[3],s=arguments[4],i=arguments[5],A=arguments[6],u=arguments[7],c=arguments[8]),"object"==typeof(e=arguments[0])&&!f(e)&&"imageData"in e){var l=e;e=l.imageData,r=l.format||r||t,n=l.x||n||0,o=l.y||o||0,s=l.w||l.width||s,i=l.h||l.height||i,A=l.alias||A,u=l.compression||u,c=l.rotation||l.angle||c}var d=this.internal.getFilters();if(void 0===u&&-1!==d.indexOf("FlateEncode")&&(u="SLOW"),isNaN(n)||isNaN(o))throw new Error("Invalid coordinates passed to jsPDF.addImage");a.call(this);var h=E.call(this,e,r,A,u);return g.call(this,n,o,s,i,h,c),this};var E=function(r,o,s,i){var a,A,c;if("string"==typeof r&&n(r)===t){r=unescape(r);var l=N(r,!1);(""!==l||void 0!==(l=e.loadFile(r,!0)))&&(r=l)}if(f(r)&&(r=h(r,o)),o=n(r,o),!d(o))throw new Error("addImage does not support files of type '"+o+"', please ensure that a plugin for '"+o+"' support is added.");if((null==(c=s)||0===c.length)&&(s=function(e){return"string"==typeof e||_(e)?w(e):null}(r)),(a=p.call(this,s))||(j()&&(r instanceof Uint8Array||(A=r,r=C(r))),a=this["process"+o.toUpperCase()](r,u.call(this),s,function(t){return t&&"string"==typeof t&&(t=t.toUpperCase()),t in e.image_compression?t:v.NONE}(i),A)),!a)throw new Error("An unknown error occurred whilst processing the image.");return a},N=e.__addimage__.convertBase64ToBinaryString=function(e,t){var r;t="boolean"!=typeof t||t;var n,o="";if("string"==typeof e){n=null!==(r=B(e))?r.data:e;try{o=c(n)}catch(e){if(t)throw b(n)?new Error("atob-Error in jsPDF.convertBase64ToBinaryString "+e.message):new Error("Supplied Data is not a valid base64-String jsPDF.convertBase64ToBinaryString ")}}return o};e.getImageProperties=function(r){var o,s,i="";if(f(r)&&(r=h(r)),"string"==typeof r&&n(r)===t&&(""===(i=N(r,!1))&&(i=e.loadFile(r)||""),r=i),s=n(r),!d(s))throw new Error("addImage does not support files of type '"+s+"', please ensure that a plugin for '"+s+"' support is added.");if(!j()||r instanceof Uint8Array||(r=C(r)),!(o=this["process"+s.toUpperCase()](r)))throw new Error("An unknown error occurred whilst processing the image");return o.fileType=s,o}}(H.API),Be=H.API,je=function(e){if(void 0!==e&&""!=e)return!0},H.API.events.push(["addPage",function(e){this.internal.getPageInfo(e.pageNumber).pageContext.annotations=[]}]),Be.events.push(["putPage",function(e){for(var t,r,n,o=this.internal.getCoordinateString,s=this.internal.getVerticalCoordinateString,i=this.internal.getPageInfoByObjId(e.objId),a=e.pageContext.annotations,A=!1,u=0;u<a.length&&!A;u++)switch((t=a[u]).type){case"link":(je(t.options.url)||je(t.options.pageNumber))&&(A=!0);break;case"reference":case"text":case"freetext":A=!0}if(0!=A){this.internal.write("/Annots [");for(var c=0;c<a.length;c++){t=a[c];var l=this.internal.pdfEscape,d=this.internal.getEncryptor(e.objId);switch(t.type){case"reference":this.internal.write(" "+t.object.objId+" 0 R ");break;case"text":var f=this.internal.newAdditionalObject(),h=this.internal.newAdditionalObject(),p=this.internal.getEncryptor(f.objId),m=t.title||"Note";n="<</Type /Annot /Subtype /Text "+(r="/Rect ["+o(t.bounds.x)+" "+s(t.bounds.y+t.bounds.h)+" "+o(t.bounds.x+t.bounds.w)+" "+s(t.bounds.y)+"] ")+"/Contents ("+l(p(t.contents))+")",n+=" /Popup "+h.objId+" 0 R",n+=" /P "+i.objId+" 0 R",n+=" /T ("+l(p(m))+") >>",f.content=n;var g=f.objId+" 0 R";n="<</Type /Annot /Subtype /Popup "+(r="/Rect ["+o(t.bounds.x+30)+" "+s(t.bounds.y+t.bounds.h)+" "+o(t.bounds.x+t.bounds.w+30)+" "+s(t.bounds.y)+"] ")+" /Parent "+g,t.open&&(n+=" /Open true"),n+=" >>",h.content=n,this.internal.write(f.objId,"0 R",h.objId,"0 R");break;case"freetext":r="/Rect ["+o(t.bounds.x)+" "+s(t.bounds.y)+" "+o(t.bounds.x+t.bounds.w)+" "+s(t.bounds.y+t.bounds.h)+"] ";var y=t.color||"#000000";n="<</Type /Annot /Subtype /FreeText "+r+"/Contents ("+l(d(t.contents))+")",n+=" /DS(font: Helvetica,sans-serif 12.0pt; text-align:left; color:#"+y+")",n+=" /Border [0 0 0]",n+=" >>",this.internal.write(n);break;case"link":if(t.options.name){var v=this.annotations._nameMap[t.options.name];t.options.pageNumber=v.page,t.options.top=v.y}else t.options.top||(t.options.top=0);if(r="/Rect ["+t.finalBounds.x+" "+t.finalBounds.y+" "+t.finalBounds.w+" "+t.finalBounds.h+"] ",n="",t.options.url)n="<</Type /Annot /Subtype /Link "+r+"/Border [0 0 0] /A <</S /URI /URI ("+l(d(t.options.url))+") >>";else if(t.options.pageNumber)switch(n="<</Type /Annot /Subtype /Link "+r+"/Border [0 0 0] /Dest ["+this.internal.getPageInfo(t.options.pageNumber).objId+" 0 R",t.options.magFactor=t.options.magFactor||"XYZ",t.options.magFactor){case"Fit":n+=" /Fit]";break;case"FitH":n+=" /FitH "+t.options.top+"]";break;case"FitV":t.options.left=t.options.left||0,n+=" /FitV "+t.options.left+"]";break;case"XYZ":default:var w=s(t.options.top);t.options.left=t.options.left||0,void 0===t.options.zoom&&(t.options.zoom=0),n+=" /XYZ "+t.options.left+" "+w+" "+t.options.zoom+"]"}""!=n&&(n+=" >>",this.internal.write(n))}}this.internal.write("]")}}]),Be.createAnnotation=function(e){var t=this.internal.getCurrentPageInfo();switch(e.type){case"link":this.link(e.bounds.x,e.bounds.y,e.bounds.w,e.bounds.h,e);break;case"text":case"freetext":t.pageContext.annotations.push(e)}},Be.link=function(e,t,r,n,o){var s=this.internal.getCurrentPageInfo(),i=this.internal.getCoordinateString,a=this.internal.getVerticalCoordinateString;s.pageContext.annotations.push({finalBounds:{x:i(e),y:a(t),w:i(e+r),h:a(t+n)},options:o,type:"link"})},Be.textWithLink=function(e,t,r,n){var o=this.getTextWidth(e),s=this.internal.getLineHeight()/this.internal.scaleFactor;return this.text(e,t,r,n),r+=.2*s,"center"===n.align&&(t-=o/2),"right"===n.align&&(t-=o),this.link(t,r-s,o,s,n),o},Be.getTextWidth=function(e){var t=this.internal.getFontSize();return this.getStringUnitWidth(e)*t/this.internal.scaleFactor},function(e){var t={1569:[65152],1570:[65153,65154],1571:[65155,65156],1572:[65157,65158],1573:[65159,65160],1574:[65161,65162,65163,65164],1575:[65165,65166],1576:[65167,65168,65169,65170],1577:[65171,65172],1578:[65173,65174,65175,65176],1579:[65177,65178,65179,65180],1580:[65181,65182,65183,65184],1581:[65185,65186,65187,65188],1582:[65189,65190,65191,65192],1583:[65193,65194],1584:[65195,65196],1585:[65197,65198],1586:[65199,65200],1587:[65201,65202,65203,65204],1588:[65205,65206,65207,65208],1589:[65209,65210,65211,65212],1590:[65213,65214,65215,65216],1591:[65217,65218,65219,65220],1592:[65221,65222,65223,65224],1593:[65225,65226,65227,65228],1594:[65229,65230,65231,65232],1601:[65233,65234,65235,65236],1602:[65237,65238,65239,65240],1603:[65241,65242,65243,65244],1604:[65245,65246,65247,65248],1605:[65249,65250,65251,65252],1606:[65253,65254,65255,65256],1607:[65257,65258,65259,65260],1608:[65261,65262],1609:[65263,65264,64488,64489],1610:[65265,65266,65267,65268],1649:[64336,64337],1655:[64477],1657:[64358,64359,64360,64361],1658:[64350,64351,64352,64353],1659:[64338,64339,64340,64341],1662:[64342,64343,64344,64345],1663:[64354,64355,64356,64357],1664:[64346,64347,64348,64349],1667:[64374,64375,64376,64377],1668:[64370,64371,64372,64373],1670:[64378,64379,64380,64381],1671:[64382,64383,64384,64385],1672:[64392,64393],1676:[64388,64389],1677:[64386,64387],1678:[64390,64391],1681:[64396,64397],1688:[64394,64395],1700:[64362,64363,64364,64365],1702:[64366,64367,64368,64369],1705:[64398,64399,64400,64401],1709:[64467,64468,64469,64470],1711:[64402,64403,64404,64405],1713:[64410,64411,64412,64413],1715:[64406,64407,64408,64409],1722:[64414,64415],1723:[64416,64417,64418,64419],1726:[64426,64427,64428,64429],1728:[64420,64421],1729:[64422,64423,64424,64425],1733:[64480,64481],1734:[64473,64474],1735:[64471,64472],1736:[64475,64476],1737:[64482,64483],1739:[64478,64479],1740:[64508,64509,64510,64511],1744:[64484,64485,64486,64487],1746:[64430,64431],1747:[64432,64433]},r={65247:{65154:65269,65156:65271,65160:65273,65166:65275},65248:{65154:65270,65156:65272,65160:65274,65166:65276},65165:{65247:{65248:{65258:65010}}},1617:{1612:64606,1613:64607,1614:64608,1615:64609,1616:64610}},n={1612:64606,1613:64607,1614:64608,1615:64609,1616:64610},o=[1570,1571,1573,1575];e.__arabicParser__={};var s=e.__arabicParser__.isInArabicSubstitutionA=function(e){return void 0!==t[e.charCodeAt(0)]},i=e.__arabicParser__.isArabicLetter=function(e){return"string"==typeof e&&/^[\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF\uFB50-\uFDFF\uFE70-\uFEFF]+$/.test(e)},a=e.__arabicParser__.isArabicEndLetter=function(e){return i(e)&&s(e)&&t[e.charCodeAt(0)].length<=2},A=e.__arabicParser__.isArabicAlfLetter=function(e){return i(e)&&o.indexOf(e.charCodeAt(0))>=0};e.__arabicParser__.arabicLetterHasIsolatedForm=function(e){return i(e)&&s(e)&&t[e.charCodeAt(0)].length>=1};var u=e.__arabicParser__.arabicLetterHasFinalForm=function(e){return i(e)&&s(e)&&t[e.charCodeAt(0)].length>=2};e.__arabicParser__.arabicLetterHasInitialForm=function(e){return i(e)&&s(e)&&t[e.charCodeAt(0)].length>=3};var c=e.__arabicParser__.arabicLetterHasMedialForm=function(e){return i(e)&&s(e)&&4==t[e.charCodeAt(0)].length},l=e.__arabicParser__.resolveLigatures=function(e){var t=0,n=r,o="",s=0;for(t=0;t<e.length;t+=1)void 0!==n[e.charCodeAt(t)]?(s++,"number"==typeof(n=n[e.charCodeAt(t)])&&(o+=String.fromCharCode(n),n=r,s=0),t===e.length-1&&(n=r,o+=e.charAt(t-(s-1)),t-=s-1,s=0)):(n=r,o+=e.charAt(t-s),t-=s,s=0);return o};e.__arabicParser__.isArabicDiacritic=function(e){return void 0!==e&&void 0!==n[e.charCodeAt(0)]};var d=e.__arabicParser__.getCorrectForm=function(e,t,r){return i(e)?!1===s(e)?-1:!u(e)||!i(t)&&!i(r)||!i(r)&&a(t)||a(e)&&!i(t)||a(e)&&A(t)||a(e)&&a(t)?0:c(e)&&i(t)&&!a(t)&&i(r)&&u(r)?3:a(e)||!i(r)?1:2:-1},f=function(e){var r=0,n=0,o=0,s="",a="",A="",u=(e=e||"").split("\\s+"),c=[];for(r=0;r<u.length;r+=1){for(c.push(""),n=0;n<u[r].length;n+=1)s=u[r][n],a=u[r][n-1],A=u[r][n+1],i(s)?(o=d(s,a,A),c[r]+=-1!==o?String.fromCharCode(t[s.charCodeAt(0)][o]):s):c[r]+=s;c[r]=l(c[r])}return c.join(" ")},h=e.__arabicParser__.processArabic=e.processArabic=function(){var e,t="string"==typeof arguments[0]?arguments[0]:arguments[0].text,r=[];if(Array.isArray(t)){var n=0;for(r=[],n=0;n<t.length;n+=1)Array.isArray(t[n])?r.push([f(t[n][0]),t[n][1],t[n][2]]):r.push([f(t[n])]);e=r}else e=f(t);return"string"==typeof arguments[0]?e:(arguments[0].text=e,arguments[0])};e.events.push(["preProcessText",h])}(H.API),H.API.autoPrint=function(e){var t;switch((e=e||{}).variant=e.variant||"non-conform",e.variant){case"javascript":this.addJS("print({});");break;case"non-conform":default:this.internal.events.subscribe("postPutResources",(function(){t=this.internal.newObject(),this.internal.out("<<"),this.internal.out("/S /Named"),this.internal.out("/Type /Action"),this.internal.out("/N /Print"),this.internal.out(">>"),this.internal.out("endobj")})),this.internal.events.subscribe("putCatalog",(function(){this.internal.out("/OpenAction "+t+" 0 R")}))}return this},function(e){var t=function(){var e=void 0;Object.defineProperty(this,"pdf",{get:function(){return e},set:function(t){e=t}});var t=150;Object.defineProperty(this,"width",{get:function(){return t},set:function(e){t=isNaN(e)||!1===Number.isInteger(e)||e<0?150:e,this.getContext("2d").pageWrapXEnabled&&(this.getContext("2d").pageWrapX=t+1)}});var r=300;Object.defineProperty(this,"height",{get:function(){return r},set:function(e){r=isNaN(e)||!1===Number.isInteger(e)||e<0?300:e,this.getContext("2d").pageWrapYEnabled&&(this.getContext("2d").pageWrapY=r+1)}});var n=[];Object.defineProperty(this,"childNodes",{get:function(){return n},set:function(e){n=e}});var o={};Object.defineProperty(this,"style",{get:function(){return o},set:function(e){o=e}}),Object.defineProperty(this,"parentNode",{})};t.prototype.getContext=function(e,t){var r;if("2d"!==(e=e||"2d"))return null;for(r in t)this.pdf.context2d.hasOwnProperty(r)&&(this.pdf.context2d[r]=t[r]);return this.pdf.context2d._canvas=this,this.pdf.context2d},t.prototype.toDataURL=function(){throw new Error("toDataURL is not implemented.")},e.events.push(["initialized",function(){this.canvas=new t,this.canvas.pdf=this}])}(H.API),function(e){var t={left:0,top:0,bottom:0,right:0},r=!1,n=function(){void 0===this.internal.__cell__&&(this.internal.__cell__={},this.internal.__cell__.padding=3,this.internal.__cell__.headerFunction=void 0,this.internal.__cell__.margins=Object.assign({},t),this.internal.__cell__.margins.width=this.getPageWidth(),o.call(this))},o=function(){this.internal.__cell__.lastCell=new s,this.internal.__cell__.pages=1},s=function(){var e=arguments[0];Object.defineProperty(this,"x",{enumerable:!0,get:function(){return e},set:function(t){e=t}});var t=arguments[1];Object.defineProperty(this,"y",{enumerable:!0,get:function(){return t},set:function(e){t=e}});var r=arguments[2];Object.defineProperty(this,"width",{enumerable:!0,get:function(){return r},set:function(e){r=e}});var n=arguments[3];Object.defineProperty(this,"height",{enumerable:!0,get:function(){return n},set:function(e){n=e}});var o=arguments[4];Object.defineProperty(this,"text",{enumerable:!0,get:function(){return o},set:function(e){o=e}});var s=arguments[5];Object.defineProperty(this,"lineNumber",{enumerable:!0,get:function(){return s},set:function(e){s=e}});var i=arguments[6];return Object.defineProperty(this,"align",{enumerable:!0,get:function(){return i},set:function(e){i=e}}),this};s.prototype.clone=function(){return new s(this.x,this.y,this.width,this.height,this.text,this.lineNumber,this.align)},s.prototype.toArray=function(){return[this.x,this.y,this.width,this.height,this.text,this.lineNumber,this.align]},e.setHeaderFunction=function(e){return n.call(this),this.internal.__cell__.headerFunction="function"==typeof e?e:void 0,this},e.getTextDimensions=function(e,t){n.call(this);var r=(t=t||{}).fontSize||this.getFontSize(),o=t.font||this.getFont(),s=t.scaleFactor||this.internal.scaleFactor,i=0,a=0,A=0,u=this;if(!Array.isArray(e)&&"string"!=typeof e){if("number"!=typeof e)throw new Error("getTextDimensions expects text-parameter to be of type String or type Number or an Array of Strings.");e=String(e)}const c=t.maxWidth;c>0?"string"==typeof e?e=this.splitTextToSize(e,c):"[object Array]"===Object.prototype.toString.call(e)&&(e=e.reduce((function(e,t){return e.concat(u.splitTextToSize(t,c))}),[])):e=Array.isArray(e)?e:[e];for(var l=0;l<e.length;l++)i<(A=this.getStringUnitWidth(e[l],{font:o})*r)&&(i=A);return 0!==i&&(a=e.length),{w:i/=s,h:Math.max((a*r*this.getLineHeightFactor()-r*(this.getLineHeightFactor()-1))/s,0)}},e.cellAddPage=function(){n.call(this),this.addPage();var e=this.internal.__cell__.margins||t;return this.internal.__cell__.lastCell=new s(e.left,e.top,void 0,void 0),this.internal.__cell__.pages+=1,this};var i=e.cell=function(){var e;e=arguments[0]instanceof s?arguments[0]:new s(arguments[0],arguments[1],arguments[2],arguments[3],arguments[4],arguments[5]),n.call(this);var o=this.internal.__cell__.lastCell,i=this.internal.__cell__.padding,a=this.internal.__cell__.margins||t,A=this.internal.__cell__.tableHeaderRow,u=this.internal.__cell__.printHeaders;return void 0!==o.lineNumber&&(o.lineNumber===e.lineNumber?(e.x=(o.x||0)+(o.width||0),e.y=o.y||0):o.y+o.height+e.height+a.bottom>this.getPageHeight()?(this.cellAddPage(),e.y=a.top,u&&A&&(this.printHeaderRow(e.lineNumber,!0),e.y+=A[0].height)):e.y=o.y+o.height||e.y),void 0!==e.text[0]&&(this.rect(e.x,e.y,e.width,e.height,!0===r?"FD":void 0),"right"===e.align?this.text(e.text,e.x+e.width-i,e.y+i,{align:"right",baseline:"top"}):"center"===e.align?this.text(e.text,e.x+e.width/2,e.y+i,{align:"center",baseline:"top",maxWidth:e.width-i-i}):this.text(e.text,e.x+i,e.y+i,{align:"left",baseline:"top",maxWidth:e.width-i-i})),this.internal.__cell__.lastCell=e,this};e.table=function(e,r,A,u,c){if(n.call(this),!A)throw new Error("No data for PDF table.");var l,d,f,h,p=[],m=[],g=[],y={},v={},w=[],b=[],B=(c=c||{}).autoSize||!1,j=!1!==c.printHeaders,_=c.css&&void 0!==c.css["font-size"]?16*c.css["font-size"]:c.fontSize||12,C=c.margins||Object.assign({width:this.getPageWidth()},t),x="number"==typeof c.padding?c.padding:3,E=c.headerBackgroundColor||"#c8c8c8";if(o.call(this),this.internal.__cell__.printHeaders=j,this.internal.__cell__.margins=C,this.internal.__cell__.table_font_size=_,this.internal.__cell__.padding=x,this.internal.__cell__.headerBackgroundColor=E,this.setFontSize(_),null==u)m=p=Object.keys(A[0]),g=p.map((function(){return"left"}));else if(Array.isArray(u)&&"object"==typeof u[0])for(p=u.map((function(e){return e.name})),m=u.map((function(e){return e.prompt||e.name||""})),g=u.map((function(e){return e.align||"left"})),l=0;l<u.length;l+=1)v[u[l].name]=u[l].width*(19.049976/25.4);else Array.isArray(u)&&"string"==typeof u[0]&&(m=p=u,g=p.map((function(){return"left"})));if(B||Array.isArray(u)&&"string"==typeof u[0])for(l=0;l<p.length;l+=1){for(y[h=p[l]]=A.map((function(e){return e[h]})),this.setFont(void 0,"bold"),w.push(this.getTextDimensions(m[l],{fontSize:this.internal.__cell__.table_font_size,scaleFactor:this.internal.scaleFactor}).w),d=y[h],this.setFont(void 0,"normal"),f=0;f<d.length;f+=1)w.push(this.getTextDimensions(d[f],{fontSize:this.internal.__cell__.table_font_size,scaleFactor:this.internal.scaleFactor}).w);v[h]=Math.max.apply(null,w)+x+x,w=[]}if(j){var N={};for(l=0;l<p.length;l+=1)N[p[l]]={},N[p[l]].text=m[l],N[p[l]].align=g[l];var Q=a.call(this,N,v);b=p.map((function(t){return new s(e,r,v[t],Q,N[t].text,void 0,N[t].align)})),this.setTableHeaderRow(b),this.printHeaderRow(1,!1)}var F=u.reduce((function(e,t){return e[t.name]=t.align,e}),{});for(l=0;l<A.length;l+=1){var U=a.call(this,A[l],v);for(f=0;f<p.length;f+=1)i.call(this,new s(e,r,v[p[f]],U,A[l][p[f]],l+2,F[p[f]]))}return this.internal.__cell__.table_x=e,this.internal.__cell__.table_y=r,this};var a=function(e,t){var r=this.internal.__cell__.padding,n=this.internal.__cell__.table_font_size,o=this.internal.scaleFactor;return Object.keys(e).map((function(n){var o=e[n];return this.splitTextToSize(o.hasOwnProperty("text")?o.text:o,t[n]-r-r)}),this).map((function(e){return this.getLineHeightFactor()*e.length*n/o+r+r}),this).reduce((function(e,t){return Math.max(e,t)}),0)};e.setTableHeaderRow=function(e){n.call(this),this.internal.__cell__.tableHeaderRow=e},e.printHeaderRow=function(e,t){if(n.call(this),!this.internal.__cell__.tableHeaderRow)throw new Error("Property tableHeaderRow does not exist.");var o;if(r=!0,"function"==typeof this.internal.__cell__.headerFunction){var a=this.internal.__cell__.headerFunction(this,this.internal.__cell__.pages);this.internal.__cell__.lastCell=new s(a[0],a[1],a[2],a[3],void 0,-1)}this.setFont(void 0,"bold");for(var A=[],u=0;u<this.internal.__cell__.tableHeaderRow.length;u+=1)o=this.internal.__cell__.tableHeaderRow[u].clone(),t&&(o.y=this.internal.__cell__.margins.top||0,A.push(o)),o.lineNumber=e,this.setFillColor(this.internal.__cell__.headerBackgroundColor),i.call(this,o);A.length>0&&this.setTableHeaderRow(A),this.setFont(void 0,"normal"),r=!1}}(H.API);var xe={italic:["italic","oblique","normal"],oblique:["oblique","italic","normal"],normal:["normal","oblique","italic"]},Ee=["ultra-condensed","extra-condensed","condensed","semi-condensed","normal","semi-expanded","expanded","extra-expanded","ultra-expanded"],Ne=Ce(Ee),Qe=[100,200,300,400,500,600,700,800,900],Fe=Ce(Qe);function Ue(e){var t=e.family.replace(/"|'/g,"").toLowerCase(),r=function(e){return xe[e=e||"normal"]?e:"normal"}(e.style),n=function(e){if(!e)return 400;if("number"==typeof e)return e>=100&&e<=900&&e%100==0?e:400;if(/^\d00$/.test(e))return parseInt(e);switch(e){case"bold":return 700;case"normal":default:return 400}}(e.weight),o=function(e){return"number"==typeof Ne[e=e||"normal"]?e:"normal"}(e.stretch);return{family:t,style:r,weight:n,stretch:o,src:e.src||[],ref:e.ref||{name:t,style:[o,r,n].join(" ")}}}function Se(e,t,r,n){var o;for(o=r;o>=0&&o<t.length;o+=n)if(e[t[o]])return e[t[o]];for(o=r;o>=0&&o<t.length;o-=n)if(e[t[o]])return e[t[o]]}var Le={"sans-serif":"helvetica",fixed:"courier",monospace:"courier",terminal:"courier",cursive:"times",fantasy:"times",serif:"times"},Te={caption:"times",icon:"times",menu:"times","message-box":"times","small-caption":"times","status-bar":"times"};function He(e){return[e.stretch,e.style,e.weight,e.family].join(" ")}function Ie(e){return e.trimLeft()}function Pe(e,t){for(var r=0;r<e.length;){if(e.charAt(r)===t)return[e.substring(0,r),e.substring(r+1)];r+=1}return null}function Oe(e){var t=e.match(/^(-[a-z_]|[a-z_])[a-z0-9_-]*/i);return null===t?null:[t[0],e.substring(t[0].length)]}var ke,Re,Me,De=["times"];!function(e){var t,r,n,o,s,a,A,u,c,l=function(e){return e=e||{},this.isStrokeTransparent=e.isStrokeTransparent||!1,this.strokeOpacity=e.strokeOpacity||1,this.strokeStyle=e.strokeStyle||"#000000",this.fillStyle=e.fillStyle||"#000000",this.isFillTransparent=e.isFillTransparent||!1,this.fillOpacity=e.fillOpacity||1,this.font=e.font||"10px sans-serif",this.textBaseline=e.textBaseline||"alphabetic",this.textAlign=e.textAlign||"left",this.lineWidth=e.lineWidth||1,this.lineJoin=e.lineJoin||"miter",this.lineCap=e.lineCap||"butt",this.path=e.path||[],this.transform=void 0!==e.transform?e.transform.clone():new u,this.globalCompositeOperation=e.globalCompositeOperation||"normal",this.globalAlpha=e.globalAlpha||1,this.clip_path=e.clip_path||[],this.currentPoint=e.currentPoint||new a,this.miterLimit=e.miterLimit||10,this.lastPoint=e.lastPoint||new a,this.ignoreClearRect="boolean"!=typeof e.ignoreClearRect||e.ignoreClearRect,this};e.events.push(["initialized",function(){this.context2d=new d(this),t=this.internal.f2,r=this.internal.getCoordinateString,n=this.internal.getVerticalCoordinateString,o=this.internal.getHorizontalCoordinate,s=this.internal.getVerticalCoordinate,a=this.internal.Point,A=this.internal.Rectangle,u=this.internal.Matrix,c=new l}]);var d=function(e){Object.defineProperty(this,"canvas",{get:function(){return{parentNode:!1,style:!1}}});var t=e;Object.defineProperty(this,"pdf",{get:function(){return t}});var r=!1;Object.defineProperty(this,"pageWrapXEnabled",{get:function(){return r},set:function(e){r=Boolean(e)}});var n=!1;Object.defineProperty(this,"pageWrapYEnabled",{get:function(){return n},set:function(e){n=Boolean(e)}});var o=0;Object.defineProperty(this,"posX",{get:function(){return o},set:function(e){isNaN(e)||(o=e)}});var s=0;Object.defineProperty(this,"posY",{get:function(){return s},set:function(e){isNaN(e)||(s=e)}});var i=!1;Object.defineProperty(this,"autoPaging",{get:function(){return i},set:function(e){i=Boolean(e)}});var a=0;Object.defineProperty(this,"lastBreak",{get:function(){return a},set:function(e){a=e}});var A=[];Object.defineProperty(this,"pageBreaks",{get:function(){return A},set:function(e){A=e}}),Object.defineProperty(this,"ctx",{get:function(){return c},set:function(e){e instanceof l&&(c=e)}}),Object.defineProperty(this,"path",{get:function(){return c.path},set:function(e){c.path=e}});var u=[];Object.defineProperty(this,"ctxStack",{get:function(){return u},set:function(e){u=e}}),Object.defineProperty(this,"fillStyle",{get:function(){return this.ctx.fillStyle},set:function(e){var t;t=h(e),this.ctx.fillStyle=t.style,this.ctx.isFillTransparent=0===t.a,this.ctx.fillOpacity=t.a,this.pdf.setFillColor(t.r,t.g,t.b,{a:t.a}),this.pdf.setTextColor(t.r,t.g,t.b,{a:t.a})}}),Object.defineProperty(this,"strokeStyle",{get:function(){return this.ctx.strokeStyle},set:function(e){var t=h(e);this.ctx.strokeStyle=t.style,this.ctx.isStrokeTransparent=0===t.a,this.ctx.strokeOpacity=t.a,0===t.a?this.pdf.setDrawColor(255,255,255):(t.a,this.pdf.setDrawColor(t.r,t.g,t.b))}}),Object.defineProperty(this,"lineCap",{get:function(){return this.ctx.lineCap},set:function(e){-1!==["butt","round","square"].indexOf(e)&&(this.ctx.lineCap=e,this.pdf.setLineCap(e))}}),Object.defineProperty(this,"lineWidth",{get:function(){return this.ctx.lineWidth},set:function(e){isNaN(e)||(this.ctx.lineWidth=e,this.pdf.setLineWidth(e))}}),Object.defineProperty(this,"lineJoin",{get:function(){return this.ctx.lineJoin},set:function(e){-1!==["bevel","round","miter"].indexOf(e)&&(this.ctx.lineJoin=e,this.pdf.setLineJoin(e))}}),Object.defineProperty(this,"miterLimit",{get:function(){return this.ctx.miterLimit},set:function(e){isNaN(e)||(this.ctx.miterLimit=e,this.pdf.setMiterLimit(e))}}),Object.defineProperty(this,"textBaseline",{get:function(){return this.ctx.textBaseline},set:function(e){this.ctx.textBaseline=e}}),Object.defineProperty(this,"textAlign",{get:function(){return this.ctx.textAlign},set:function(e){-1!==["right","end","center","left","start"].indexOf(e)&&(this.ctx.textAlign=e)}});var d=null;function f(e,t){if(null===d){var r=function(e){var t=[];return Object.keys(e).forEach((function(r){e[r].forEach((function(e){var n=null;switch(e){case"bold":n={family:r,weight:"bold"};break;case"italic":n={family:r,style:"italic"};break;case"bolditalic":n={family:r,weight:"bold",style:"italic"};break;case"":case"normal":n={family:r}}null!==n&&(n.ref={name:r,style:e},t.push(n))}))})),t}(e.getFontList());d=function(e){for(var t={},r=0;r<e.length;++r){var n=Ue(e[r]),o=n.family,s=n.stretch,i=n.style,a=n.weight;t[o]=t[o]||{},t[o][s]=t[o][s]||{},t[o][s][i]=t[o][s][i]||{},t[o][s][i][a]=n}return t}(r.concat(t))}return d}var p=null;Object.defineProperty(this,"fontFaces",{get:function(){return p},set:function(e){d=null,p=e}}),Object.defineProperty(this,"font",{get:function(){return this.ctx.font},set:function(e){var t;if(this.ctx.font=e,null!==(t=/^\s*(?=(?:(?:[-a-z]+\s*){0,2}(italic|oblique))?)(?=(?:(?:[-a-z]+\s*){0,2}(small-caps))?)(?=(?:(?:[-a-z]+\s*){0,2}(bold(?:er)?|lighter|[1-9]00))?)(?:(?:normal|\1|\2|\3)\s*){0,3}((?:xx?-)?(?:small|large)|medium|smaller|larger|[.\d]+(?:\%|in|[cem]m|ex|p[ctx]))(?:\s*\/\s*(normal|[.\d]+(?:\%|in|[cem]m|ex|p[ctx])))?\s*([-_,\"\'\sa-z]+?)\s*$/i.exec(e))){var r=t[1],n=(t[2],t[3]),o=t[4],s=(t[5],t[6]),i=/^([.\d]+)((?:%|in|[cem]m|ex|p[ctx]))$/i.exec(o)[2];o="px"===i?Math.floor(parseFloat(o)*this.pdf.internal.scaleFactor):"em"===i?Math.floor(parseFloat(o)*this.pdf.getFontSize()):Math.floor(parseFloat(o)*this.pdf.internal.scaleFactor),this.pdf.setFontSize(o);var a=function(e){var t,r,n=[],o=e.trim();if(""===o)return De;if(o in Te)return[Te[o]];for(;""!==o;){switch(r=null,t=(o=Ie(o)).charAt(0)){case'"':case"'":r=Pe(o.substring(1),t);break;default:r=Oe(o)}if(null===r)return De;if(n.push(r[0]),""!==(o=Ie(r[1]))&&","!==o.charAt(0))return De;o=o.replace(/^,/,"")}return n}(s);if(this.fontFaces){var A=function(e,t,r){for(var n=(r=r||{}).defaultFontFamily||"times",o=Object.assign({},Le,r.genericFontFamilies||{}),s=null,i=null,a=0;a<t.length;++a)if(o[(s=Ue(t[a])).family]&&(s.family=o[s.family]),e.hasOwnProperty(s.family)){i=e[s.family];break}if(!(i=i||e[n]))throw new Error("Could not find a font-family for the rule '"+He(s)+"' and default family '"+n+"'.");if(i=function(e,t){if(t[e])return t[e];var r=Ne[e],n=r<=Ne.normal?-1:1,o=Se(t,Ee,r,n);if(!o)throw new Error("Could not find a matching font-stretch value for "+e);return o}(s.stretch,i),i=function(e,t){if(t[e])return t[e];for(var r=xe[e],n=0;n<r.length;++n)if(t[r[n]])return t[r[n]];throw new Error("Could not find a matching font-style for "+e)}(s.style,i),!(i=function(e,t){if(t[e])return t[e];if(400===e&&t[500])return t[500];if(500===e&&t[400])return t[400];var r=Fe[e],n=Se(t,Qe,r,e<400?-1:1);if(!n)throw new Error("Could not find a matching font-weight for value "+e);return n}(s.weight,i)))throw new Error("Failed to resolve a font for the rule '"+He(s)+"'.");return i}(f(this.pdf,this.fontFaces),a.map((function(e){return{family:e,stretch:"normal",weight:n,style:r}})));this.pdf.setFont(A.ref.name,A.ref.style)}else{var u="";("bold"===n||parseInt(n,10)>=700||"bold"===r)&&(u="bold"),"italic"===r&&(u+="italic"),0===u.length&&(u="normal");for(var c="",l={arial:"Helvetica",Arial:"Helvetica",verdana:"Helvetica",Verdana:"Helvetica",helvetica:"Helvetica",Helvetica:"Helvetica","sans-serif":"Helvetica",fixed:"Courier",monospace:"Courier",terminal:"Courier",cursive:"Times",fantasy:"Times",serif:"Times"},d=0;d<a.length;d++){if(void 0!==this.pdf.internal.getFont(a[d],u,{noFallback:!0,disableWarning:!0})){c=a[d];break}if("bolditalic"===u&&void 0!==this.pdf.internal.getFont(a[d],"bold",{noFallback:!0,disableWarning:!0}))c=a[d],u="bold";else if(void 0!==this.pdf.internal.getFont(a[d],"normal",{noFallback:!0,disableWarning:!0})){c=a[d],u="normal";break}}if(""===c)for(var h=0;h<a.length;h++)if(l[a[h]]){c=l[a[h]];break}c=""===c?"Times":c,this.pdf.setFont(c,u)}}}}),Object.defineProperty(this,"globalCompositeOperation",{get:function(){return this.ctx.globalCompositeOperation},set:function(e){this.ctx.globalCompositeOperation=e}}),Object.defineProperty(this,"globalAlpha",{get:function(){return this.ctx.globalAlpha},set:function(e){this.ctx.globalAlpha=e}}),Object.defineProperty(this,"ignoreClearRect",{get:function(){return this.ctx.ignoreClearRect},set:function(e){this.ctx.ignoreClearRect=Boolean(e)}})};d.prototype.fill=function(){b.call(this,"fill",!1)},d.prototype.stroke=function(){b.call(this,"stroke",!1)},d.prototype.beginPath=function(){this.path=[{type:"begin"}]},d.prototype.moveTo=function(e,t){if(isNaN(e)||isNaN(t))throw i.error("jsPDF.context2d.moveTo: Invalid arguments",arguments),new Error("Invalid arguments passed to jsPDF.context2d.moveTo");var r=this.ctx.transform.applyToPoint(new a(e,t));this.path.push({type:"mt",x:r.x,y:r.y}),this.ctx.lastPoint=new a(e,t)},d.prototype.closePath=function(){var e=new a(0,0),t=0;for(t=this.path.length-1;-1!==t;t--)if("begin"===this.path[t].type&&"object"==typeof this.path[t+1]&&"number"==typeof this.path[t+1].x){e=new a(this.path[t+1].x,this.path[t+1].y),this.path.push({type:"lt",x:e.x,y:e.y});break}"object"==typeof this.path[t+2]&&"number"==typeof this.path[t+2].x&&this.path.push(JSON.parse(JSON.stringify(this.path[t+2]))),this.path.push({type:"close"}),this.ctx.lastPoint=new a(e.x,e.y)},d.prototype.lineTo=function(e,t){if(isNaN(e)||isNaN(t))throw i.error("jsPDF.context2d.lineTo: Invalid arguments",arguments),new Error("Invalid arguments passed to jsPDF.context2d.lineTo");var r=this.ctx.transform.applyToPoint(new a(e,t));this.path.push({type:"lt",x:r.x,y:r.y}),this.ctx.lastPoint=new a(r.x,r.y)},d.prototype.clip=function(){this.ctx.clip_path=JSON.parse(JSON.stringify(this.path)),b.call(this,null,!0)},d.prototype.quadraticCurveTo=function(e,t,r,n){if(isNaN(r)||isNaN(n)||isNaN(e)||isNaN(t))throw i.error("jsPDF.context2d.quadraticCurveTo: Invalid arguments",arguments),new Error("Invalid arguments passed to jsPDF.context2d.quadraticCurveTo");var o=this.ctx.transform.applyToPoint(new a(r,n)),s=this.ctx.transform.applyToPoint(new a(e,t));this.path.push({type:"qct",x1:s.x,y1:s.y,x:o.x,y:o.y}),this.ctx.lastPoint=new a(o.x,o.y)},d.prototype.bezierCurveTo=function(e,t,r,n,o,s){if(isNaN(o)||isNaN(s)||isNaN(e)||isNaN(t)||isNaN(r)||isNaN(n))throw i.error("jsPDF.context2d.bezierCurveTo: Invalid arguments",arguments),new Error("Invalid arguments passed to jsPDF.context2d.bezierCurveTo");var A=this.ctx.transform.applyToPoint(new a(o,s)),u=this.ctx.transform.applyToPoint(new a(e,t)),c=this.ctx.transform.applyToPoint(new a(r,n));this.path.push({type:"bct",x1:u.x,y1:u.y,x2:c.x,y2:c.y,x:A.x,y:A.y}),this.ctx.lastPoint=new a(A.x,A.y)},d.prototype.arc=function(e,t,r,n,o,s){if(isNaN(e)||isNaN(t)||isNaN(r)||isNaN(n)||isNaN(o))throw i.error("jsPDF.context2d.arc: Invalid arguments",arguments),new Error("Invalid arguments passed to jsPDF.context2d.arc");if(s=Boolean(s),!this.ctx.transform.isIdentity){var A=this.ctx.transform.applyToPoint(new a(e,t));e=A.x,t=A.y;var u=this.ctx.transform.applyToPoint(new a(0,r)),c=this.ctx.transform.applyToPoint(new a(0,0));r=Math.sqrt(Math.pow(u.x-c.x,2)+Math.pow(u.y-c.y,2))}Math.abs(o-n)>=2*Math.PI&&(n=0,o=2*Math.PI),this.path.push({type:"arc",x:e,y:t,radius:r,startAngle:n,endAngle:o,counterclockwise:s})},d.prototype.arcTo=function(e,t,r,n,o){throw new Error("arcTo not implemented.")},d.prototype.rect=function(e,t,r,n){if(isNaN(e)||isNaN(t)||isNaN(r)||isNaN(n))throw i.error("jsPDF.context2d.rect: Invalid arguments",arguments),new Error("Invalid arguments passed to jsPDF.context2d.rect");this.moveTo(e,t),this.lineTo(e+r,t),this.lineTo(e+r,t+n),this.lineTo(e,t+n),this.lineTo(e,t),this.lineTo(e+r,t),this.lineTo(e,t)},d.prototype.fillRect=function(e,t,r,n){if(isNaN(e)||isNaN(t)||isNaN(r)||isNaN(n))throw i.error("jsPDF.context2d.fillRect: Invalid arguments",arguments),new Error("Invalid arguments passed to jsPDF.context2d.fillRect");if(!p.call(this)){var o={};"butt"!==this.lineCap&&(o.lineCap=this.lineCap,this.lineCap="butt"),"miter"!==this.lineJoin&&(o.lineJoin=this.lineJoin,this.lineJoin="miter"),this.beginPath(),this.rect(e,t,r,n),this.fill(),o.hasOwnProperty("lineCap")&&(this.lineCap=o.lineCap),o.hasOwnProperty("lineJoin")&&(this.lineJoin=o.lineJoin)}},d.prototype.strokeRect=function(e,t,r,n){if(isNaN(e)||isNaN(t)||isNaN(r)||isNaN(n))throw i.error("jsPDF.context2d.strokeRect: Invalid arguments",arguments),new Error("Invalid arguments passed to jsPDF.context2d.strokeRect");m.call(this)||(this.beginPath(),this.rect(e,t,r,n),this.stroke())},d.prototype.clearRect=function(e,t,r,n){if(isNaN(e)||isNaN(t)||isNaN(r)||isNaN(n))throw i.error("jsPDF.context2d.clearRect: Invalid arguments",arguments),new Error("Invalid arguments passed to jsPDF.context2d.clearRect");this.ignoreClearRect||(this.fillStyle="#ffffff",this.fillRect(e,t,r,n))},d.prototype.save=function(e){e="boolean"!=typeof e||e;for(var t=this.pdf.internal.getCurrentPageInfo().pageNumber,r=0;r<this.pdf.internal.getNumberOfPages();r++)this.pdf.setPage(r+1),this.pdf.internal.out("q");if(this.pdf.setPage(t),e){this.ctx.fontSize=this.pdf.internal.getFontSize();var n=new l(this.ctx);this.ctxStack.push(this.ctx),this.ctx=n}},d.prototype.restore=function(e){e="boolean"!=typeof e||e;for(var t=this.pdf.internal.getCurrentPageInfo().pageNumber,r=0;r<this.pdf.internal.getNumberOfPages();r++)this.pdf.setPage(r+1),this.pdf.internal.out("Q");this.pdf.setPage(t),e&&0!==this.ctxStack.length&&(this.ctx=this.ctxStack.pop(),this.fillStyle=this.ctx.fillStyle,this.strokeStyle=this.ctx.strokeStyle,this.font=this.ctx.font,this.lineCap=this.ctx.lineCap,this.lineWidth=this.ctx.lineWidth,this.lineJoin=this.ctx.lineJoin)},d.prototype.toDataURL=function(){throw new Error("toDataUrl not implemented.")};var h=function(e){var t,r,n,o;if(!0===e.isCanvasGradient&&(e=e.getColor()),!e)return{r:0,g:0,b:0,a:0,style:e};if(/transparent|rgba\s*\(\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*,\s*0+\s*\)/.test(e))t=0,r=0,n=0,o=0;else{var s=/rgb\s*\(\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*\)/.exec(e);if(null!==s)t=parseInt(s[1]),r=parseInt(s[2]),n=parseInt(s[3]),o=1;else if(null!==(s=/rgba\s*\(\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*,\s*([\d.]+)\s*\)/.exec(e)))t=parseInt(s[1]),r=parseInt(s[2]),n=parseInt(s[3]),o=parseFloat(s[4]);else{if(o=1,"string"==typeof e&&"#"!==e.charAt(0)){var i=new f(e);e=i.ok?i.toHex():"#000000"}4===e.length?(t=e.substring(1,2),t+=t,r=e.substring(2,3),r+=r,n=e.substring(3,4),n+=n):(t=e.substring(1,3),r=e.substring(3,5),n=e.substring(5,7)),t=parseInt(t,16),r=parseInt(r,16),n=parseInt(n,16)}}return{r:t,g:r,b:n,a:o,style:e}},p=function(){return this.ctx.isFillTransparent||0==this.globalAlpha},m=function(){return Boolean(this.ctx.isStrokeTransparent||0==this.globalAlpha)};d.prototype.fillText=function(e,t,r,n){if(isNaN(t)||isNaN(r)||"string"!=typeof e)throw i.error("jsPDF.context2d.fillText: Invalid arguments",arguments),new Error("Invalid arguments passed to jsPDF.context2d.fillText");if(n=isNaN(n)?void 0:n,!p.call(this)){r=j.call(this,r);var o=T(this.ctx.transform.rotation),s=this.ctx.transform.scaleX;N.call(this,{text:e,x:t,y:r,scale:s,angle:o,align:this.textAlign,maxWidth:n})}},d.prototype.strokeText=function(e,t,r,n){if(isNaN(t)||isNaN(r)||"string"!=typeof e)throw i.error("jsPDF.context2d.strokeText: Invalid arguments",arguments),new Error("Invalid arguments passed to jsPDF.context2d.strokeText");if(!m.call(this)){n=isNaN(n)?void 0:n,r=j.call(this,r);var o=T(this.ctx.transform.rotation),s=this.ctx.transform.scaleX;N.call(this,{text:e,x:t,y:r,scale:s,renderingMode:"stroke",angle:o,align:this.textAlign,maxWidth:n})}},d.prototype.measureText=function(e){if("string"!=typeof e)throw i.error("jsPDF.context2d.measureText: Invalid arguments",arguments),new Error("Invalid arguments passed to jsPDF.context2d.measureText");var t=this.pdf,r=this.pdf.internal.scaleFactor,n=t.internal.getFontSize(),o=t.getStringUnitWidth(e)*n/t.internal.scaleFactor,s=function(e){var t=(e=e||{}).width||0;return Object.defineProperty(this,"width",{get:function(){return t}}),this};return new s({width:o*=Math.round(96*r/72*1e4)/1e4})},d.prototype.scale=function(e,t){if(isNaN(e)||isNaN(t))throw i.error("jsPDF.context2d.scale: Invalid arguments",arguments),new Error("Invalid arguments passed to jsPDF.context2d.scale");var r=new u(e,0,0,t,0,0);this.ctx.transform=this.ctx.transform.multiply(r)},d.prototype.rotate=function(e){if(isNaN(e))throw i.error("jsPDF.context2d.rotate: Invalid arguments",arguments),new Error("Invalid arguments passed to jsPDF.context2d.rotate");var t=new u(Math.cos(e),Math.sin(e),-Math.sin(e),Math.cos(e),0,0);this.ctx.transform=this.ctx.transform.multiply(t)},d.prototype.translate=function(e,t){if(isNaN(e)||isNaN(t))throw i.error("jsPDF.context2d.translate: Invalid arguments",arguments),new Error("Invalid arguments passed to jsPDF.context2d.translate");var r=new u(1,0,0,1,e,t);this.ctx.transform=this.ctx.transform.multiply(r)},d.prototype.transform=function(e,t,r,n,o,s){if(isNaN(e)||isNaN(t)||isNaN(r)||isNaN(n)||isNaN(o)||isNaN(s))throw i.error("jsPDF.context2d.transform: Invalid arguments",arguments),new Error("Invalid arguments passed to jsPDF.context2d.transform");var a=new u(e,t,r,n,o,s);this.ctx.transform=this.ctx.transform.multiply(a)},d.prototype.setTransform=function(e,t,r,n,o,s){e=isNaN(e)?1:e,t=isNaN(t)?0:t,r=isNaN(r)?0:r,n=isNaN(n)?1:n,o=isNaN(o)?0:o,s=isNaN(s)?0:s,this.ctx.transform=new u(e,t,r,n,o,s)},d.prototype.drawImage=function(e,t,r,n,o,s,i,a,c){var l=this.pdf.getImageProperties(e),d=1,f=1,h=1,p=1;void 0!==n&&void 0!==a&&(h=a/n,p=c/o,d=l.width/n*a/n,f=l.height/o*c/o),void 0===s&&(s=t,i=r,t=0,r=0),void 0!==n&&void 0===a&&(a=n,c=o),void 0===n&&void 0===a&&(a=l.width,c=l.height);for(var m,y=this.ctx.transform.decompose(),b=T(y.rotate.shx),j=new u,_=(j=(j=(j=j.multiply(y.translate)).multiply(y.skew)).multiply(y.scale)).applyToRectangle(new A(s-t*h,i-r*p,n*d,o*f)),C=g.call(this,_),x=[],E=0;E<C.length;E+=1)-1===x.indexOf(C[E])&&x.push(C[E]);if(w(x),this.autoPaging)for(var N=x[0],Q=x[x.length-1],F=N;F<Q+1;F++){if(this.pdf.setPage(F),0!==this.ctx.clip_path.length){var U=this.path;m=JSON.parse(JSON.stringify(this.ctx.clip_path)),this.path=v(m,this.posX,-1*this.pdf.internal.pageSize.height*(F-1)+this.posY),B.call(this,"fill",!0),this.path=U}var S=JSON.parse(JSON.stringify(_));S=v([S],this.posX,-1*this.pdf.internal.pageSize.height*(F-1)+this.posY)[0],this.pdf.addImage(e,"JPEG",S.x,S.y,S.w,S.h,null,null,b)}else this.pdf.addImage(e,"JPEG",_.x,_.y,_.w,_.h,null,null,b)};var g=function(e,t,r){var n=[];switch(t=t||this.pdf.internal.pageSize.width,r=r||this.pdf.internal.pageSize.height,e.type){default:case"mt":case"lt":n.push(Math.floor((e.y+this.posY)/r)+1);break;case"arc":n.push(Math.floor((e.y+this.posY-e.radius)/r)+1),n.push(Math.floor((e.y+this.posY+e.radius)/r)+1);break;case"qct":var o=H(this.ctx.lastPoint.x,this.ctx.lastPoint.y,e.x1,e.y1,e.x,e.y);n.push(Math.floor(o.y/r)+1),n.push(Math.floor((o.y+o.h)/r)+1);break;case"bct":var s=I(this.ctx.lastPoint.x,this.ctx.lastPoint.y,e.x1,e.y1,e.x2,e.y2,e.x,e.y);n.push(Math.floor(s.y/r)+1),n.push(Math.floor((s.y+s.h)/r)+1);break;case"rect":n.push(Math.floor((e.y+this.posY)/r)+1),n.push(Math.floor((e.y+e.h+this.posY)/r)+1)}for(var i=0;i<n.length;i+=1)for(;this.pdf.internal.getNumberOfPages()<n[i];)y.call(this);return n},y=function(){var e=this.fillStyle,t=this.strokeStyle,r=this.font,n=this.lineCap,o=this.lineWidth,s=this.lineJoin;this.pdf.addPage(),this.fillStyle=e,this.strokeStyle=t,this.font=r,this.lineCap=n,this.lineWidth=o,this.lineJoin=s},v=function(e,t,r){for(var n=0;n<e.length;n++)switch(e[n].type){case"bct":e[n].x2+=t,e[n].y2+=r;case"qct":e[n].x1+=t,e[n].y1+=r;case"mt":case"lt":case"arc":default:e[n].x+=t,e[n].y+=r}return e},w=function(e){return e.sort((function(e,t){return e-t}))},b=function(e,t){for(var r,n,o=this.fillStyle,s=this.strokeStyle,i=this.lineCap,a=this.lineWidth,A=a*this.ctx.transform.scaleX,u=this.lineJoin,c=JSON.parse(JSON.stringify(this.path)),l=JSON.parse(JSON.stringify(this.path)),d=[],f=0;f<l.length;f++)if(void 0!==l[f].x)for(var h=g.call(this,l[f]),p=0;p<h.length;p+=1)-1===d.indexOf(h[p])&&d.push(h[p]);for(var m=0;m<d.length;m++)for(;this.pdf.internal.getNumberOfPages()<d[m];)y.call(this);if(w(d),this.autoPaging)for(var b=d[0],j=d[d.length-1],_=b;_<j+1;_++){if(this.pdf.setPage(_),this.fillStyle=o,this.strokeStyle=s,this.lineCap=i,this.lineWidth=A,this.lineJoin=u,0!==this.ctx.clip_path.length){var C=this.path;r=JSON.parse(JSON.stringify(this.ctx.clip_path)),this.path=v(r,this.posX,-1*this.pdf.internal.pageSize.height*(_-1)+this.posY),B.call(this,e,!0),this.path=C}n=JSON.parse(JSON.stringify(c)),this.path=v(n,this.posX,-1*this.pdf.internal.pageSize.height*(_-1)+this.posY),!1!==t&&0!==_||B.call(this,e,t),this.lineWidth=a}else this.lineWidth=A,B.call(this,e,t),this.lineWidth=a;this.path=c},B=function(e,t){if(("stroke"!==e||t||!m.call(this))&&("stroke"===e||t||!p.call(this))){for(var r,n,o=[],s=this.path,i=0;i<s.length;i++){var a=s[i];switch(a.type){case"begin":o.push({begin:!0});break;case"close":o.push({close:!0});break;case"mt":o.push({start:a,deltas:[],abs:[]});break;case"lt":var A=o.length;if(!isNaN(s[i-1].x)&&(r=[a.x-s[i-1].x,a.y-s[i-1].y],A>0))for(;A>=0;A--)if(!0!==o[A-1].close&&!0!==o[A-1].begin){o[A-1].deltas.push(r),o[A-1].abs.push(a);break}break;case"bct":r=[a.x1-s[i-1].x,a.y1-s[i-1].y,a.x2-s[i-1].x,a.y2-s[i-1].y,a.x-s[i-1].x,a.y-s[i-1].y],o[o.length-1].deltas.push(r);break;case"qct":var u=s[i-1].x+2/3*(a.x1-s[i-1].x),c=s[i-1].y+2/3*(a.y1-s[i-1].y),l=a.x+2/3*(a.x1-a.x),d=a.y+2/3*(a.y1-a.y),f=a.x,h=a.y;r=[u-s[i-1].x,c-s[i-1].y,l-s[i-1].x,d-s[i-1].y,f-s[i-1].x,h-s[i-1].y],o[o.length-1].deltas.push(r);break;case"arc":o.push({deltas:[],abs:[],arc:!0}),Array.isArray(o[o.length-1].abs)&&o[o.length-1].abs.push(a)}}n=t?null:"stroke"===e?"stroke":"fill";for(var g=0;g<o.length;g++){if(o[g].arc){for(var y=o[g].abs,v=0;v<y.length;v++){var w=y[v];"arc"===w.type?_.call(this,w.x,w.y,w.radius,w.startAngle,w.endAngle,w.counterclockwise,void 0,t):Q.call(this,w.x,w.y)}C.call(this,n),this.pdf.internal.out("h")}if(!o[g].arc&&!0!==o[g].close&&!0!==o[g].begin){var b=o[g].start.x,B=o[g].start.y;F.call(this,o[g].deltas,b,B)}}n&&C.call(this,n),t&&x.call(this)}},j=function(e){var t=this.pdf.internal.getFontSize()/this.pdf.internal.scaleFactor,r=t*(this.pdf.internal.getLineHeightFactor()-1);switch(this.ctx.textBaseline){case"bottom":return e-r;case"top":return e+t-r;case"hanging":return e+t-2*r;case"middle":return e+t/2-r;case"ideographic":return e;case"alphabetic":default:return e}};d.prototype.createLinearGradient=function(){var e=function(){};return e.colorStops=[],e.addColorStop=function(e,t){this.colorStops.push([e,t])},e.getColor=function(){return 0===this.colorStops.length?"#000000":this.colorStops[0][1]},e.isCanvasGradient=!0,e},d.prototype.createPattern=function(){return this.createLinearGradient()},d.prototype.createRadialGradient=function(){return this.createLinearGradient()};var _=function(e,t,r,n,o,s,i,a){for(var A=S.call(this,r,n,o,s),u=0;u<A.length;u++){var c=A[u];0===u&&E.call(this,c.x1+e,c.y1+t),U.call(this,e,t,c.x2,c.y2,c.x3,c.y3,c.x4,c.y4)}a?x.call(this):C.call(this,i)},C=function(e){switch(e){case"stroke":this.pdf.internal.out("S");break;case"fill":this.pdf.internal.out("f")}},x=function(){this.pdf.clip(),this.pdf.discardPath()},E=function(e,t){this.pdf.internal.out(r(e)+" "+n(t)+" m")},N=function(e){var t;switch(e.align){case"right":case"end":t="right";break;case"center":t="center";break;case"left":case"start":default:t="left"}var r=this.ctx.transform.applyToPoint(new a(e.x,e.y)),n=this.ctx.transform.decompose(),o=new u;o=(o=(o=o.multiply(n.translate)).multiply(n.skew)).multiply(n.scale);for(var s,i,c,l=this.pdf.getTextDimensions(e.text),d=this.ctx.transform.applyToRectangle(new A(e.x,e.y,l.w,l.h)),f=o.applyToRectangle(new A(e.x,e.y-l.h,l.w,l.h)),h=g.call(this,f),p=[],m=0;m<h.length;m+=1)-1===p.indexOf(h[m])&&p.push(h[m]);if(w(p),!0===this.autoPaging)for(var y=p[0],b=p[p.length-1],j=y;j<b+1;j++){if(this.pdf.setPage(j),0!==this.ctx.clip_path.length){var _=this.path;s=JSON.parse(JSON.stringify(this.ctx.clip_path)),this.path=v(s,this.posX,-1*this.pdf.internal.pageSize.height*(j-1)+this.posY),B.call(this,"fill",!0),this.path=_}var C=JSON.parse(JSON.stringify(d));C=v([C],this.posX,-1*this.pdf.internal.pageSize.height*(j-1)+this.posY)[0],e.scale>=.01&&(i=this.pdf.internal.getFontSize(),this.pdf.setFontSize(i*e.scale),c=this.lineWidth,this.lineWidth=c*e.scale),this.pdf.text(e.text,C.x,C.y,{angle:e.angle,align:t,renderingMode:e.renderingMode,maxWidth:e.maxWidth}),e.scale>=.01&&(this.pdf.setFontSize(i),this.lineWidth=c)}else e.scale>=.01&&(i=this.pdf.internal.getFontSize(),this.pdf.setFontSize(i*e.scale),c=this.lineWidth,this.lineWidth=c*e.scale),this.pdf.text(e.text,r.x+this.posX,r.y+this.posY,{angle:e.angle,align:t,renderingMode:e.renderingMode,maxWidth:e.maxWidth}),e.scale>=.01&&(this.pdf.setFontSize(i),this.lineWidth=c)},Q=function(e,t,o,s){o=o||0,s=s||0,this.pdf.internal.out(r(e+o)+" "+n(t+s)+" l")},F=function(e,t,r){return this.pdf.lines(e,t,r,null,null)},U=function(e,r,n,i,a,A,u,c){this.pdf.internal.out([t(o(n+e)),t(s(i+r)),t(o(a+e)),t(s(A+r)),t(o(u+e)),t(s(c+r)),"c"].join(" "))},S=function(e,t,r,n){for(var o=2*Math.PI,s=Math.PI/2;t>r;)t-=o;var i=Math.abs(r-t);i<o&&n&&(i=o-i);for(var a=[],A=n?-1:1,u=t;i>1e-5;){var c=u+A*Math.min(i,s);a.push(L.call(this,e,u,c)),i-=Math.abs(c-u),u=c}return a},L=function(e,t,r){var n=(r-t)/2,o=e*Math.cos(n),s=e*Math.sin(n),i=o,a=-s,A=i*i+a*a,u=A+i*o+a*s,c=4/3*(Math.sqrt(2*A*u)-u)/(i*s-a*o),l=i-c*a,d=a+c*i,f=l,h=-d,p=n+t,m=Math.cos(p),g=Math.sin(p);return{x1:e*Math.cos(t),y1:e*Math.sin(t),x2:l*m-d*g,y2:l*g+d*m,x3:f*m-h*g,y3:f*g+h*m,x4:e*Math.cos(r),y4:e*Math.sin(r)}},T=function(e){return 180*e/Math.PI},H=function(e,t,r,n,o,s){var i=e+.5*(r-e),a=t+.5*(n-t),u=o+.5*(r-o),c=s+.5*(n-s),l=Math.min(e,o,i,u),d=Math.max(e,o,i,u),f=Math.min(t,s,a,c),h=Math.max(t,s,a,c);return new A(l,f,d-l,h-f)},I=function(e,t,r,n,o,s,i,a){var u,c,l,d,f,h,p,m,g,y,v,w,b,B,j=r-e,_=n-t,C=o-r,x=s-n,E=i-o,N=a-s;for(c=0;c<41;c++)g=(p=(l=e+(u=c/40)*j)+u*((f=r+u*C)-l))+u*(f+u*(o+u*E-f)-p),y=(m=(d=t+u*_)+u*((h=n+u*x)-d))+u*(h+u*(s+u*N-h)-m),0==c?(v=g,w=y,b=g,B=y):(v=Math.min(v,g),w=Math.min(w,y),b=Math.max(b,g),B=Math.max(B,y));return new A(Math.round(v),Math.round(w),Math.round(b-v),Math.round(B-w))}}(H.API),function(e){var t=function(e){var t,r,n,o,s,i,a,A,u,c;for(/[^\x00-\xFF]/.test(e),r=[],n=0,o=(e+=t="\0\0\0\0".slice(e.length%4||4)).length;o>n;n+=4)0!==(s=(e.charCodeAt(n)<<24)+(e.charCodeAt(n+1)<<16)+(e.charCodeAt(n+2)<<8)+e.charCodeAt(n+3))?(i=(s=((s=((s=((s=(s-(c=s%85))/85)-(u=s%85))/85)-(A=s%85))/85)-(a=s%85))/85)%85,r.push(i+33,a+33,A+33,u+33,c+33)):r.push(122);return function(e,t){for(var r=t;r>0;r--)e.pop()}(r,t.length),String.fromCharCode.apply(String,r)+"~>"},r=function(e){var t,r,n,o,s,i=String,a="length",A=255,u="charCodeAt",c="slice",l="replace";for(e[c](-2),e=e[c](0,-2)[l](/\s/g,"")[l]("z","!!!!!"),n=[],o=0,s=(e+=t="uuuuu"[c](e[a]%5||5))[a];s>o;o+=5)r=52200625*(e[u](o)-33)+614125*(e[u](o+1)-33)+7225*(e[u](o+2)-33)+85*(e[u](o+3)-33)+(e[u](o+4)-33),n.push(A&r>>24,A&r>>16,A&r>>8,A&r);return function(e,t){for(var r=t;r>0;r--)e.pop()}(n,t[a]),i.fromCharCode.apply(i,n)},o=function(e){var t=new RegExp(/^([0-9A-Fa-f]{2})+$/);if(-1!==(e=e.replace(/\s/g,"")).indexOf(">")&&(e=e.substr(0,e.indexOf(">"))),e.length%2&&(e+="0"),!1===t.test(e))return"";for(var r="",n=0;n<e.length;n+=2)r+=String.fromCharCode("0x"+(e[n]+e[n+1]));return r},s=function(e){for(var t=new Uint8Array(e.length),r=e.length;r--;)t[r]=e.charCodeAt(r);return(t=(0,n.zlibSync)(t)).reduce((function(e,t){return e+String.fromCharCode(t)}),"")};e.processDataByFilters=function(e,n){var i=0,a=e||"",A=[];for("string"==typeof(n=n||[])&&(n=[n]),i=0;i<n.length;i+=1)switch(n[i]){case"ASCII85Decode":case"/ASCII85Decode":a=r(a),A.push("/ASCII85Encode");break;case"ASCII85Encode":case"/ASCII85Encode":a=t(a),A.push("/ASCII85Decode");break;case"ASCIIHexDecode":case"/ASCIIHexDecode":a=o(a),A.push("/ASCIIHexEncode");break;case"ASCIIHexEncode":case"/ASCIIHexEncode":a=a.split("").map((function(e){return("0"+e.charCodeAt().toString(16)).slice(-2)})).join("")+">",A.push("/ASCIIHexDecode");break;case"FlateEncode":case"/FlateEncode":a=s(a),A.push("/FlateDecode");break;default:throw new Error('The filter: "'+n[i]+'" is not implemented')}return{data:a,reverseChain:A.reverse().join(" ")}}}(H.API),function(e){e.loadFile=function(e,t,r){return function(e,t,r){t=!1!==t,r="function"==typeof r?r:function(){};var n=void 0;try{n=function(e,t,r){var n=new XMLHttpRequest,o=0,s=function(e){var t=e.length,r=[],n=String.fromCharCode;for(o=0;o<t;o+=1)r.push(n(255&e.charCodeAt(o)));return r.join("")};if(n.open("GET",e,!t),n.overrideMimeType("text/plain; charset=x-user-defined"),!1===t&&(n.onload=function(){200===n.status?r(s(this.responseText)):r(void 0)}),n.send(null),t&&200===n.status)return s(n.responseText)}(e,t,r)}catch(e){}return n}(e,t,r)},e.loadImageFile=e.loadFile}(H.API),function(e){function t(){return(o.html2canvas?Promise.resolve(o.html2canvas):Promise.resolve().then(r.t.bind(r,"./node_modules/html2canvas/dist/html2canvas.js",23))).catch((function(e){return Promise.reject(new Error("Could not load html2canvas: "+e))})).then((function(e){return e.default?e.default:e}))}function n(){return(o.DOMPurify?Promise.resolve(o.DOMPurify):Promise.resolve().then(r.t.bind(r,"./node_modules/dompurify/dist/purify.js",23))).catch((function(e){return Promise.reject(new Error("Could not load dompurify: "+e))})).then((function(e){return e.default?e.default:e}))}var s=function(e){var t=typeof e;return"undefined"===t?"undefined":"string"===t||e instanceof String?"string":"number"===t||e instanceof Number?"number":"function"===t||e instanceof Function?"function":e&&e.constructor===Array?"array":e&&1===e.nodeType?"element":"object"===t?"object":"unknown"},i=function(e,t){var r=document.createElement(e);for(var n in t.className&&(r.className=t.className),t.innerHTML&&t.dompurify&&(r.innerHTML=t.dompurify.sanitize(t.innerHTML)),t.style)r.style[n]=t.style[n];return r},a=function(e,t){for(var r=3===e.nodeType?document.createTextNode(e.nodeValue):e.cloneNode(!1),n=e.firstChild;n;n=n.nextSibling)!0!==t&&1===n.nodeType&&"SCRIPT"===n.nodeName||r.appendChild(a(n,t));return 1===e.nodeType&&("CANVAS"===e.nodeName?(r.width=e.width,r.height=e.height,r.getContext("2d").drawImage(e,0,0)):"TEXTAREA"!==e.nodeName&&"SELECT"!==e.nodeName||(r.value=e.value),r.addEventListener("load",(function(){r.scrollTop=e.scrollTop,r.scrollLeft=e.scrollLeft}),!0)),r},A=function e(t){var r=Object.assign(e.convert(Promise.resolve()),JSON.parse(JSON.stringify(e.template))),n=e.convert(Promise.resolve(),r);return(n=n.setProgress(1,e,1,[e])).set(t)};(A.prototype=Object.create(Promise.prototype)).constructor=A,A.convert=function(e,t){return e.__proto__=t||A.prototype,e},A.template={prop:{src:null,container:null,overlay:null,canvas:null,img:null,pdf:null,pageSize:null,callback:function(){}},progress:{val:0,state:null,n:0,stack:[]},opt:{filename:"file.pdf",margin:[0,0,0,0],enableLinks:!0,x:0,y:0,html2canvas:{},jsPDF:{},backgroundColor:"transparent"}},A.prototype.from=function(e,t){return this.then((function(){switch(t=t||function(e){switch(s(e)){case"string":return"string";case"element":return"canvas"===e.nodeName.toLowerCase()?"canvas":"element";default:return"unknown"}}(e)){case"string":return this.then(n).then((function(t){return this.set({src:i("div",{innerHTML:e,dompurify:t})})}));case"element":return this.set({src:e});case"canvas":return this.set({canvas:e});case"img":return this.set({img:e});default:return this.error("Unknown source type.")}}))},A.prototype.to=function(e){switch(e){case"container":return this.toContainer();case"canvas":return this.toCanvas();case"img":return this.toImg();case"pdf":return this.toPdf();default:return this.error("Invalid target.")}},A.prototype.toContainer=function(){return this.thenList([function(){return this.prop.src||this.error("Cannot duplicate - no source HTML.")},function(){return this.prop.pageSize||this.setPageSize()}]).then((function(){var e={position:"relative",display:"inline-block",width:Math.max(this.prop.src.clientWidth,this.prop.src.scrollWidth,this.prop.src.offsetWidth)+"px",left:0,right:0,top:0,margin:"auto",backgroundColor:this.opt.backgroundColor},t=a(this.prop.src,this.opt.html2canvas.javascriptEnabled);"BODY"===t.tagName&&(e.height=Math.max(document.body.scrollHeight,document.body.offsetHeight,document.documentElement.clientHeight,document.documentElement.scrollHeight,document.documentElement.offsetHeight)+"px"),this.prop.overlay=i("div",{className:"html2pdf__overlay",style:{position:"fixed",overflow:"hidden",zIndex:1e3,left:"-100000px",right:0,bottom:0,top:0}}),this.prop.container=i("div",{className:"html2pdf__container",style:e}),this.prop.container.appendChild(t),this.prop.container.firstChild.appendChild(i("div",{style:{clear:"both",border:"0 none transparent",margin:0,padding:0,height:0}})),this.prop.container.style.float="none",this.prop.overlay.appendChild(this.prop.container),document.body.appendChild(this.prop.overlay),this.prop.container.firstChild.style.position="relative",this.prop.container.height=Math.max(this.prop.container.firstChild.clientHeight,this.prop.container.firstChild.scrollHeight,this.prop.container.firstChild.offsetHeight)+"px"}))},A.prototype.toCanvas=function(){var e=[function(){return document.body.contains(this.prop.container)||this.toContainer()}];return this.thenList(e).then(t).then((function(e){var t=Object.assign({},this.opt.html2canvas);return delete t.onrendered,e(this.prop.container,t)})).then((function(e){(this.opt.html2canvas.onrendered||function(){})(e),this.prop.canvas=e,document.body.removeChild(this.prop.overlay)}))},A.prototype.toContext2d=function(){var e=[function(){return document.body.contains(this.prop.container)||this.toContainer()}];return this.thenList(e).then(t).then((function(e){var t=this.opt.jsPDF,r=this.opt.fontFaces,n=Object.assign({async:!0,allowTaint:!0,scale:1,scrollX:this.opt.scrollX||0,scrollY:this.opt.scrollY||0,backgroundColor:"#ffffff",imageTimeout:15e3,logging:!0,proxy:null,removeContainer:!0,foreignObjectRendering:!1,useCORS:!1},this.opt.html2canvas);if(delete n.onrendered,t.context2d.autoPaging=!0,t.context2d.posX=this.opt.x,t.context2d.posY=this.opt.y,t.context2d.fontFaces=r,r)for(var o=0;o<r.length;++o){var s=r[o],i=s.src.find((function(e){return"truetype"===e.format}));i&&t.addFont(i.url,s.ref.name,s.ref.style)}return n.windowHeight=n.windowHeight||0,n.windowHeight=0==n.windowHeight?Math.max(this.prop.container.clientHeight,this.prop.container.scrollHeight,this.prop.container.offsetHeight):n.windowHeight,e(this.prop.container,n)})).then((function(e){(this.opt.html2canvas.onrendered||function(){})(e),this.prop.canvas=e,document.body.removeChild(this.prop.overlay)}))},A.prototype.toImg=function(){return this.thenList([function(){return this.prop.canvas||this.toCanvas()}]).then((function(){var e=this.prop.canvas.toDataURL("image/"+this.opt.image.type,this.opt.image.quality);this.prop.img=document.createElement("img"),this.prop.img.src=e}))},A.prototype.toPdf=function(){return this.thenList([function(){return this.toContext2d()}]).then((function(){this.prop.pdf=this.prop.pdf||this.opt.jsPDF}))},A.prototype.output=function(e,t,r){return"img"===(r=r||"pdf").toLowerCase()||"image"===r.toLowerCase()?this.outputImg(e,t):this.outputPdf(e,t)},A.prototype.outputPdf=function(e,t){return this.thenList([function(){return this.prop.pdf||this.toPdf()}]).then((function(){return this.prop.pdf.output(e,t)}))},A.prototype.outputImg=function(e){return this.thenList([function(){return this.prop.img||this.toImg()}]).then((function(){switch(e){case void 0:case"img":return this.prop.img;case"datauristring":case"dataurlstring":return this.prop.img.src;case"datauri":case"dataurl":return document.location.href=this.prop.img.src;default:throw'Image output type "'+e+'" is not supported.'}}))},A.prototype.save=function(e){return this.thenList([function(){return this.prop.pdf||this.toPdf()}]).set(e?{filename:e}:null).then((function(){this.prop.pdf.save(this.opt.filename)}))},A.prototype.doCallback=function(){return this.thenList([function(){return this.prop.pdf||this.toPdf()}]).then((function(){this.prop.callback(this.prop.pdf)}))},A.prototype.set=function(e){if("object"!==s(e))return this;var t=Object.keys(e||{}).map((function(t){if(t in A.template.prop)return function(){this.prop[t]=e[t]};switch(t){case"margin":return this.setMargin.bind(this,e.margin);case"jsPDF":return function(){return this.opt.jsPDF=e.jsPDF,this.setPageSize()};case"pageSize":return this.setPageSize.bind(this,e.pageSize);default:return function(){this.opt[t]=e[t]}}}),this);return this.then((function(){return this.thenList(t)}))},A.prototype.get=function(e,t){return this.then((function(){var r=e in A.template.prop?this.prop[e]:this.opt[e];return t?t(r):r}))},A.prototype.setMargin=function(e){return this.then((function(){switch(s(e)){case"number":e=[e,e,e,e];case"array":if(2===e.length&&(e=[e[0],e[1],e[0],e[1]]),4===e.length)break;default:return this.error("Invalid margin array.")}this.opt.margin=e})).then(this.setPageSize)},A.prototype.setPageSize=function(e){function t(e,t){return Math.floor(e*t/72*96)}return this.then((function(){(e=e||H.getPageSize(this.opt.jsPDF)).hasOwnProperty("inner")||(e.inner={width:e.width-this.opt.margin[1]-this.opt.margin[3],height:e.height-this.opt.margin[0]-this.opt.margin[2]},e.inner.px={width:t(e.inner.width,e.k),height:t(e.inner.height,e.k)},e.inner.ratio=e.inner.height/e.inner.width),this.prop.pageSize=e}))},A.prototype.setProgress=function(e,t,r,n){return null!=e&&(this.progress.val=e),null!=t&&(this.progress.state=t),null!=r&&(this.progress.n=r),null!=n&&(this.progress.stack=n),this.progress.ratio=this.progress.val/this.progress.state,this},A.prototype.updateProgress=function(e,t,r,n){return this.setProgress(e?this.progress.val+e:null,t||null,r?this.progress.n+r:null,n?this.progress.stack.concat(n):null)},A.prototype.then=function(e,t){var r=this;return this.thenCore(e,t,(function(e,t){return r.updateProgress(null,null,1,[e]),Promise.prototype.then.call(this,(function(t){return r.updateProgress(null,e),t})).then(e,t).then((function(e){return r.updateProgress(1),e}))}))},A.prototype.thenCore=function(e,t,r){r=r||Promise.prototype.then,e&&(e=e.bind(this)),t&&(t=t.bind(this));var n=-1!==Promise.toString().indexOf("[native code]")&&"Promise"===Promise.name?this:A.convert(Object.assign({},this),Promise.prototype),o=r.call(n,e,t);return A.convert(o,this.__proto__)},A.prototype.thenExternal=function(e,t){return Promise.prototype.then.call(this,e,t)},A.prototype.thenList=function(e){var t=this;return e.forEach((function(e){t=t.thenCore(e)})),t},A.prototype.catch=function(e){e&&(e=e.bind(this));var t=Promise.prototype.catch.call(this,e);return A.convert(t,this)},A.prototype.catchExternal=function(e){return Promise.prototype.catch.call(this,e)},A.prototype.error=function(e){return this.then((function(){throw new Error(e)}))},A.prototype.using=A.prototype.set,A.prototype.saveAs=A.prototype.save,A.prototype.export=A.prototype.output,A.prototype.run=A.prototype.then,H.getPageSize=function(e,t,r){if("object"==typeof e){var n=e;e=n.orientation,t=n.unit||t,r=n.format||r}t=t||"mm",r=r||"a4",e=(""+(e||"P")).toLowerCase();var o,s=(""+r).toLowerCase(),i={a0:[2383.94,3370.39],a1:[1683.78,2383.94],a2:[1190.55,1683.78],a3:[841.89,1190.55],a4:[595.28,841.89],a5:[419.53,595.28],a6:[297.64,419.53],a7:[209.76,297.64],a8:[147.4,209.76],a9:[104.88,147.4],a10:[73.7,104.88],b0:[2834.65,4008.19],b1:[2004.09,2834.65],b2:[1417.32,2004.09],b3:[1000.63,1417.32],b4:[708.66,1000.63],b5:[498.9,708.66],b6:[354.33,498.9],b7:[249.45,354.33],b8:[175.75,249.45],b9:[124.72,175.75],b10:[87.87,124.72],c0:[2599.37,3676.54],c1:[1836.85,2599.37],c2:[1298.27,1836.85],c3:[918.43,1298.27],c4:[649.13,918.43],c5:[459.21,649.13],c6:[323.15,459.21],c7:[229.61,323.15],c8:[161.57,229.61],c9:[113.39,161.57],c10:[79.37,113.39],dl:[311.81,623.62],letter:[612,792],"government-letter":[576,756],legal:[612,1008],"junior-legal":[576,360],ledger:[1224,792],tabloid:[792,1224],"credit-card":[153,243]};switch(t){case"pt":o=1;break;case"mm":o=72/25.4;break;case"cm":o=72/2.54;break;case"in":o=72;break;case"px":o=.75;break;case"pc":case"em":o=12;break;case"ex":o=6;break;default:throw"Invalid unit: "+t}var a,A=0,u=0;if(i.hasOwnProperty(s))A=i[s][1]/o,u=i[s][0]/o;else try{A=r[1],u=r[0]}catch(e){throw new Error("Invalid format: "+r)}if("p"===e||"portrait"===e)e="p",u>A&&(a=u,u=A,A=a);else{if("l"!==e&&"landscape"!==e)throw"Invalid orientation: "+e;e="l",A>u&&(a=u,u=A,A=a)}return{width:u,height:A,unit:t,k:o,orientation:e}},e.html=function(e,t){(t=t||{}).callback=t.callback||function(){},t.html2canvas=t.html2canvas||{},t.html2canvas.canvas=t.html2canvas.canvas||this.canvas,t.jsPDF=t.jsPDF||this,t.fontFaces=t.fontFaces?t.fontFaces.map(Ue):null;var r=new A(t);return t.worker?r:r.from(e).doCallback()}}(H.API),H.API.addJS=function(e){return Me=e,this.internal.events.subscribe("postPutResources",(function(){ke=this.internal.newObject(),this.internal.out("<<"),this.internal.out("/Names [(EmbeddedJS) "+(ke+1)+" 0 R]"),this.internal.out(">>"),this.internal.out("endobj"),Re=this.internal.newObject(),this.internal.out("<<"),this.internal.out("/S /JavaScript"),this.internal.out("/JS ("+Me+")"),this.internal.out(">>"),this.internal.out("endobj")})),this.internal.events.subscribe("putCatalog",(function(){void 0!==ke&&void 0!==Re&&this.internal.out("/Names <</JavaScript "+ke+" 0 R>>")})),this},function(e){var t;e.events.push(["postPutResources",function(){var e=this,r=/^(\d+) 0 obj$/;if(this.outline.root.children.length>0)for(var n=e.outline.render().split(/\r\n/),o=0;o<n.length;o++){var s=n[o],i=r.exec(s);if(null!=i){var a=i[1];e.internal.newObjectDeferredBegin(a,!1)}e.internal.write(s)}if(this.outline.createNamedDestinations){var A=this.internal.pages.length,u=[];for(o=0;o<A;o++){var c=e.internal.newObject();u.push(c);var l=e.internal.getPageInfo(o+1);e.internal.write("<< /D["+l.objId+" 0 R /XYZ null null null]>> endobj")}var d=e.internal.newObject();for(e.internal.write("<< /Names [ "),o=0;o<u.length;o++)e.internal.write("(page_"+(o+1)+")"+u[o]+" 0 R");e.internal.write(" ] >>","endobj"),t=e.internal.newObject(),e.internal.write("<< /Dests "+d+" 0 R"),e.internal.write(">>","endobj")}}]),e.events.push(["putCatalog",function(){this.outline.root.children.length>0&&(this.internal.write("/Outlines",this.outline.makeRef(this.outline.root)),this.outline.createNamedDestinations&&this.internal.write("/Names "+t+" 0 R"))}]),e.events.push(["initialized",function(){var e=this;e.outline={createNamedDestinations:!1,root:{children:[]}},e.outline.add=function(e,t,r){var n={title:t,options:r,children:[]};return null==e&&(e=this.root),e.children.push(n),n},e.outline.render=function(){return this.ctx={},this.ctx.val="",this.ctx.pdf=e,this.genIds_r(this.root),this.renderRoot(this.root),this.renderItems(this.root),this.ctx.val},e.outline.genIds_r=function(t){t.id=e.internal.newObjectDeferred();for(var r=0;r<t.children.length;r++)this.genIds_r(t.children[r])},e.outline.renderRoot=function(e){this.objStart(e),this.line("/Type /Outlines"),e.children.length>0&&(this.line("/First "+this.makeRef(e.children[0])),this.line("/Last "+this.makeRef(e.children[e.children.length-1]))),this.line("/Count "+this.count_r({count:0},e)),this.objEnd()},e.outline.renderItems=function(t){for(var r=this.ctx.pdf.internal.getVerticalCoordinateString,n=0;n<t.children.length;n++){var o=t.children[n];this.objStart(o),this.line("/Title "+this.makeString(o.title)),this.line("/Parent "+this.makeRef(t)),n>0&&this.line("/Prev "+this.makeRef(t.children[n-1])),n<t.children.length-1&&this.line("/Next "+this.makeRef(t.children[n+1])),o.children.length>0&&(this.line("/First "+this.makeRef(o.children[0])),this.line("/Last "+this.makeRef(o.children[o.children.length-1])));var s=this.count=this.count_r({count:0},o);if(s>0&&this.line("/Count "+s),o.options&&o.options.pageNumber){var i=e.internal.getPageInfo(o.options.pageNumber);this.line("/Dest ["+i.objId+" 0 R /XYZ 0 "+r(0)+" 0]")}this.objEnd()}for(var a=0;a<t.children.length;a++)this.renderItems(t.children[a])},e.outline.line=function(e){this.ctx.val+=e+"\r\n"},e.outline.makeRef=function(e){return e.id+" 0 R"},e.outline.makeString=function(t){return"("+e.internal.pdfEscape(t)+")"},e.outline.objStart=function(e){this.ctx.val+="\r\n"+e.id+" 0 obj\r\n<<\r\n"},e.outline.objEnd=function(){this.ctx.val+=">> \r\nendobj\r\n"},e.outline.count_r=function(e,t){for(var r=0;r<t.children.length;r++)e.count++,this.count_r(e,t.children[r]);return e.count}}])}(H.API),function(e){var t=[192,193,194,195,196,197,198,199];e.processJPEG=function(e,r,n,o,s,i){var a,A=this.decode.DCT_DECODE,u=null;if("string"==typeof e||this.__addimage__.isArrayBuffer(e)||this.__addimage__.isArrayBufferView(e)){switch(e=s||e,e=this.__addimage__.isArrayBuffer(e)?new Uint8Array(e):e,(a=function(e){for(var r,n=256*e.charCodeAt(4)+e.charCodeAt(5),o=e.length,s={width:0,height:0,numcomponents:1},i=4;i<o;i+=2){if(i+=n,-1!==t.indexOf(e.charCodeAt(i+1))){r=256*e.charCodeAt(i+5)+e.charCodeAt(i+6),s={width:256*e.charCodeAt(i+7)+e.charCodeAt(i+8),height:r,numcomponents:e.charCodeAt(i+9)};break}n=256*e.charCodeAt(i+2)+e.charCodeAt(i+3)}return s}(e=this.__addimage__.isArrayBufferView(e)?this.__addimage__.arrayBufferToBinaryString(e):e)).numcomponents){case 1:i=this.color_spaces.DEVICE_GRAY;break;case 4:i=this.color_spaces.DEVICE_CMYK;break;case 3:i=this.color_spaces.DEVICE_RGB}u={data:e,width:a.width,height:a.height,colorSpace:i,bitsPerComponent:8,filter:A,index:r,alias:n}}return u}}(H.API);var Ke,ze,Ve,qe,Ge,Xe=function(){var e,t,r;function s(e){var t,r,n,o,s,i,a,A,u,c,l,d,f,h;for(this.data=e,this.pos=8,this.palette=[],this.imgData=[],this.transparency={},this.animation=null,this.text={},i=null;;){switch(t=this.readUInt32(),u=function(){var e,t;for(t=[],e=0;e<4;++e)t.push(String.fromCharCode(this.data[this.pos++]));return t}.call(this).join("")){case"IHDR":this.width=this.readUInt32(),this.height=this.readUInt32(),this.bits=this.data[this.pos++],this.colorType=this.data[this.pos++],this.compressionMethod=this.data[this.pos++],this.filterMethod=this.data[this.pos++],this.interlaceMethod=this.data[this.pos++];break;case"acTL":this.animation={numFrames:this.readUInt32(),numPlays:this.readUInt32()||1/0,frames:[]};break;case"PLTE":this.palette=this.read(t);break;case"fcTL":i&&this.animation.frames.push(i),this.pos+=4,i={width:this.readUInt32(),height:this.readUInt32(),xOffset:this.readUInt32(),yOffset:this.readUInt32()},s=this.readUInt16(),o=this.readUInt16()||100,i.delay=1e3*s/o,i.disposeOp=this.data[this.pos++],i.blendOp=this.data[this.pos++],i.data=[];break;case"IDAT":case"fdAT":for("fdAT"===u&&(this.pos+=4,t-=4),e=(null!=i?i.data:void 0)||this.imgData,d=0;0<=t?d<t:d>t;0<=t?++d:--d)e.push(this.data[this.pos++]);break;case"tRNS":switch(this.transparency={},this.colorType){case 3:if(n=this.palette.length/3,this.transparency.indexed=this.read(t),this.transparency.indexed.length>n)throw new Error("More transparent colors than palette size");if((c=n-this.transparency.indexed.length)>0)for(f=0;0<=c?f<c:f>c;0<=c?++f:--f)this.transparency.indexed.push(255);break;case 0:this.transparency.grayscale=this.read(t)[0];break;case 2:this.transparency.rgb=this.read(t)}break;case"tEXt":a=(l=this.read(t)).indexOf(0),A=String.fromCharCode.apply(String,l.slice(0,a)),this.text[A]=String.fromCharCode.apply(String,l.slice(a+1));break;case"IEND":return i&&this.animation.frames.push(i),this.colors=function(){switch(this.colorType){case 0:case 3:case 4:return 1;case 2:case 6:return 3}}.call(this),this.hasAlphaChannel=4===(h=this.colorType)||6===h,r=this.colors+(this.hasAlphaChannel?1:0),this.pixelBitlength=this.bits*r,this.colorSpace=function(){switch(this.colors){case 1:return"DeviceGray";case 3:return"DeviceRGB"}}.call(this),void(this.imgData=new Uint8Array(this.imgData));default:this.pos+=t}if(this.pos+=4,this.pos>this.data.length)throw new Error("Incomplete or corrupt PNG file")}}s.prototype.read=function(e){var t,r;for(r=[],t=0;0<=e?t<e:t>e;0<=e?++t:--t)r.push(this.data[this.pos++]);return r},s.prototype.readUInt32=function(){return this.data[this.pos++]<<24|this.data[this.pos++]<<16|this.data[this.pos++]<<8|this.data[this.pos++]},s.prototype.readUInt16=function(){return this.data[this.pos++]<<8|this.data[this.pos++]},s.prototype.decodePixels=function(e){var t=this.pixelBitlength/8,r=new Uint8Array(this.width*this.height*t),o=0,s=this;if(null==e&&(e=this.imgData),0===e.length)return new Uint8Array(0);function i(n,i,a,A){var u,c,l,d,f,h,p,m,g,y,v,w,b,B,j,_,C,x,E,N,Q,F=Math.ceil((s.width-n)/a),U=Math.ceil((s.height-i)/A),S=s.width==F&&s.height==U;for(B=t*F,w=S?r:new Uint8Array(B*U),h=e.length,b=0,c=0;b<U&&o<h;){switch(e[o++]){case 0:for(d=C=0;C<B;d=C+=1)w[c++]=e[o++];break;case 1:for(d=x=0;x<B;d=x+=1)u=e[o++],f=d<t?0:w[c-t],w[c++]=(u+f)%256;break;case 2:for(d=E=0;E<B;d=E+=1)u=e[o++],l=(d-d%t)/t,j=b&&w[(b-1)*B+l*t+d%t],w[c++]=(j+u)%256;break;case 3:for(d=N=0;N<B;d=N+=1)u=e[o++],l=(d-d%t)/t,f=d<t?0:w[c-t],j=b&&w[(b-1)*B+l*t+d%t],w[c++]=(u+Math.floor((f+j)/2))%256;break;case 4:for(d=Q=0;Q<B;d=Q+=1)u=e[o++],l=(d-d%t)/t,f=d<t?0:w[c-t],0===b?j=_=0:(j=w[(b-1)*B+l*t+d%t],_=l&&w[(b-1)*B+(l-1)*t+d%t]),p=f+j-_,m=Math.abs(p-f),y=Math.abs(p-j),v=Math.abs(p-_),g=m<=y&&m<=v?f:y<=v?j:_,w[c++]=(u+g)%256;break;default:throw new Error("Invalid filter algorithm: "+e[o-1])}if(!S){var L=((i+b*A)*s.width+n)*t,T=b*B;for(d=0;d<F;d+=1){for(var H=0;H<t;H+=1)r[L++]=w[T++];L+=(a-1)*t}}b++}}return e=(0,n.unzlibSync)(e),1==s.interlaceMethod?(i(0,0,8,8),i(4,0,8,8),i(0,4,4,8),i(2,0,4,4),i(0,2,2,4),i(1,0,2,2),i(0,1,1,2)):i(0,0,1,1),r},s.prototype.decodePalette=function(){var e,t,r,n,o,s,i,a,A;for(r=this.palette,s=this.transparency.indexed||[],o=new Uint8Array((s.length||0)+r.length),n=0,e=0,t=i=0,a=r.length;i<a;t=i+=3)o[n++]=r[t],o[n++]=r[t+1],o[n++]=r[t+2],o[n++]=null!=(A=s[e++])?A:255;return o},s.prototype.copyToImageData=function(e,t){var r,n,o,s,i,a,A,u,c,l,d;if(n=this.colors,c=null,r=this.hasAlphaChannel,this.palette.length&&(c=null!=(d=this._decodedPalette)?d:this._decodedPalette=this.decodePalette(),n=4,r=!0),u=(o=e.data||e).length,i=c||t,s=a=0,1===n)for(;s<u;)A=c?4*t[s/4]:a,l=i[A++],o[s++]=l,o[s++]=l,o[s++]=l,o[s++]=r?i[A++]:255,a=A;else for(;s<u;)A=c?4*t[s/4]:a,o[s++]=i[A++],o[s++]=i[A++],o[s++]=i[A++],o[s++]=r?i[A++]:255,a=A},s.prototype.decode=function(){var e;return e=new Uint8Array(this.width*this.height*4),this.copyToImageData(e,this.decodePixels()),e};var i=function(){if("[object Window]"===Object.prototype.toString.call(o)){try{t=o.document.createElement("canvas"),r=t.getContext("2d")}catch(e){return!1}return!0}return!1};return i(),e=function(e){var n;if(!0===i())return r.width=e.width,r.height=e.height,r.clearRect(0,0,e.width,e.height),r.putImageData(e,0,0),(n=new Image).src=t.toDataURL(),n;throw new Error("This method requires a Browser with Canvas-capability.")},s.prototype.decodeFrames=function(t){var r,n,o,s,i,a,A,u;if(this.animation){for(u=[],n=i=0,a=(A=this.animation.frames).length;i<a;n=++i)r=A[n],o=t.createImageData(r.width,r.height),s=this.decodePixels(new Uint8Array(r.data)),this.copyToImageData(o,s),r.imageData=o,u.push(r.image=e(o));return u}},s.prototype.renderFrame=function(e,t){var r,n,o;return r=(n=this.animation.frames)[t],o=n[t-1],0===t&&e.clearRect(0,0,this.width,this.height),1===(null!=o?o.disposeOp:void 0)?e.clearRect(o.xOffset,o.yOffset,o.width,o.height):2===(null!=o?o.disposeOp:void 0)&&e.putImageData(o.imageData,o.xOffset,o.yOffset),0===r.blendOp&&e.clearRect(r.xOffset,r.yOffset,r.width,r.height),e.drawImage(r.image,r.xOffset,r.yOffset)},s.prototype.animate=function(e){var t,r,n,o,s,i,a=this;return r=0,i=this.animation,o=i.numFrames,n=i.frames,s=i.numPlays,(t=function(){var i,A;if(i=r++%o,A=n[i],a.renderFrame(e,i),o>1&&r/o<s)return a.animation._timeout=setTimeout(t,A.delay)})()},s.prototype.stopAnimation=function(){var e;return clearTimeout(null!=(e=this.animation)?e._timeout:void 0)},s.prototype.render=function(e){var t,r;return e._png&&e._png.stopAnimation(),e._png=this,e.width=this.width,e.height=this.height,t=e.getContext("2d"),this.animation?(this.decodeFrames(t),this.animate(t)):(r=t.createImageData(this.width,this.height),this.copyToImageData(r,this.decodePixels()),t.putImageData(r,0,0))},s}();function We(e){var t=0;if(71!==e[t++]||73!==e[t++]||70!==e[t++]||56!==e[t++]||56!=(e[t++]+1&253)||97!==e[t++])throw new Error("Invalid GIF 87a/89a header.");var r=e[t++]|e[t++]<<8,n=e[t++]|e[t++]<<8,o=e[t++],s=o>>7,i=1<<1+(7&o);e[t++],e[t++];var a=null,A=null;s&&(a=t,A=i,t+=3*i);var u=!0,c=[],l=0,d=null,f=0,h=null;for(this.width=r,this.height=n;u&&t<e.length;)switch(e[t++]){case 33:switch(e[t++]){case 255:if(11!==e[t]||78==e[t+1]&&69==e[t+2]&&84==e[t+3]&&83==e[t+4]&&67==e[t+5]&&65==e[t+6]&&80==e[t+7]&&69==e[t+8]&&50==e[t+9]&&46==e[t+10]&&48==e[t+11]&&3==e[t+12]&&1==e[t+13]&&0==e[t+16])t+=14,h=e[t++]|e[t++]<<8,t++;else for(t+=12;;){if(!((E=e[t++])>=0))throw Error("Invalid block size");if(0===E)break;t+=E}break;case 249:if(4!==e[t++]||0!==e[t+4])throw new Error("Invalid graphics extension block.");var p=e[t++];l=e[t++]|e[t++]<<8,d=e[t++],0==(1&p)&&(d=null),f=p>>2&7,t++;break;case 254:for(;;){if(!((E=e[t++])>=0))throw Error("Invalid block size");if(0===E)break;t+=E}break;default:throw new Error("Unknown graphic control label: 0x"+e[t-1].toString(16))}break;case 44:var m=e[t++]|e[t++]<<8,g=e[t++]|e[t++]<<8,y=e[t++]|e[t++]<<8,v=e[t++]|e[t++]<<8,w=e[t++],b=w>>6&1,B=1<<1+(7&w),j=a,_=A,C=!1;w>>7&&(C=!0,j=t,_=B,t+=3*B);var x=t;for(t++;;){var E;if(!((E=e[t++])>=0))throw Error("Invalid block size");if(0===E)break;t+=E}c.push({x:m,y:g,width:y,height:v,has_local_palette:C,palette_offset:j,palette_size:_,data_offset:x,data_length:t-x,transparent_index:d,interlaced:!!b,delay:l,disposal:f});break;case 59:u=!1;break;default:throw new Error("Unknown gif block: 0x"+e[t-1].toString(16))}this.numFrames=function(){return c.length},this.loopCount=function(){return h},this.frameInfo=function(e){if(e<0||e>=c.length)throw new Error("Frame index out of range.");return c[e]},this.decodeAndBlitFrameBGRA=function(t,n){var o=this.frameInfo(t),s=o.width*o.height,i=new Uint8Array(s);Je(e,o.data_offset,i,s);var a=o.palette_offset,A=o.transparent_index;null===A&&(A=256);var u=o.width,c=r-u,l=u,d=4*(o.y*r+o.x),f=4*((o.y+o.height)*r+o.x),h=d,p=4*c;!0===o.interlaced&&(p+=4*r*7);for(var m=8,g=0,y=i.length;g<y;++g){var v=i[g];if(0===l&&(l=u,(h+=p)>=f&&(p=4*c+4*r*(m-1),h=d+(u+c)*(m<<1),m>>=1)),v===A)h+=4;else{var w=e[a+3*v],b=e[a+3*v+1],B=e[a+3*v+2];n[h++]=B,n[h++]=b,n[h++]=w,n[h++]=255}--l}},this.decodeAndBlitFrameRGBA=function(t,n){var o=this.frameInfo(t),s=o.width*o.height,i=new Uint8Array(s);Je(e,o.data_offset,i,s);var a=o.palette_offset,A=o.transparent_index;null===A&&(A=256);var u=o.width,c=r-u,l=u,d=4*(o.y*r+o.x),f=4*((o.y+o.height)*r+o.x),h=d,p=4*c;!0===o.interlaced&&(p+=4*r*7);for(var m=8,g=0,y=i.length;g<y;++g){var v=i[g];if(0===l&&(l=u,(h+=p)>=f&&(p=4*c+4*r*(m-1),h=d+(u+c)*(m<<1),m>>=1)),v===A)h+=4;else{var w=e[a+3*v],b=e[a+3*v+1],B=e[a+3*v+2];n[h++]=w,n[h++]=b,n[h++]=B,n[h++]=255}--l}}}function Je(e,t,r,n){for(var o=e[t++],s=1<<o,a=s+1,A=a+1,u=o+1,c=(1<<u)-1,l=0,d=0,f=0,h=e[t++],p=new Int32Array(4096),m=null;;){for(;l<16&&0!==h;)d|=e[t++]<<l,l+=8,1===h?h=e[t++]:--h;if(l<u)break;var g=d&c;if(d>>=u,l-=u,g!==s){if(g===a)break;for(var y=g<A?g:m,v=0,w=y;w>s;)w=p[w]>>8,++v;var b=w;if(f+v+(y!==g?1:0)>n)return void i.log("Warning, gif stream longer than expected.");r[f++]=b;var B=f+=v;for(y!==g&&(r[f++]=b),w=y;v--;)w=p[w],r[--B]=255&w,w>>=8;null!==m&&A<4096&&(p[A++]=m<<8|b,A>=c+1&&u<12&&(++u,c=c<<1|1)),m=g}else A=a+1,c=(1<<(u=o+1))-1,m=null}return f!==n&&i.log("Warning, gif stream shorter than expected."),r}function Ye(e){var t,r,n,o,s,i=Math.floor,a=new Array(64),A=new Array(64),u=new Array(64),c=new Array(64),l=new Array(65535),d=new Array(65535),f=new Array(64),h=new Array(64),p=[],m=0,g=7,y=new Array(64),v=new Array(64),w=new Array(64),b=new Array(256),B=new Array(2048),j=[0,1,5,6,14,15,27,28,2,4,7,13,16,26,29,42,3,8,12,17,25,30,41,43,9,11,18,24,31,40,44,53,10,19,23,32,39,45,52,54,20,22,33,38,46,51,55,60,21,34,37,47,50,56,59,61,35,36,48,49,57,58,62,63],_=[0,0,1,5,1,1,1,1,1,1,0,0,0,0,0,0,0],C=[0,1,2,3,4,5,6,7,8,9,10,11],x=[0,0,2,1,3,3,2,4,3,5,5,4,4,0,0,1,125],E=[1,2,3,0,4,17,5,18,33,49,65,6,19,81,97,7,34,113,20,50,129,145,161,8,35,66,177,193,21,82,209,240,36,51,98,114,130,9,10,22,23,24,25,26,37,38,39,40,41,42,52,53,54,55,56,57,58,67,68,69,70,71,72,73,74,83,84,85,86,87,88,89,90,99,100,101,102,103,104,105,106,115,116,117,118,119,120,121,122,131,132,133,134,135,136,137,138,146,147,148,149,150,151,152,153,154,162,163,164,165,166,167,168,169,170,178,179,180,181,182,183,184,185,186,194,195,196,197,198,199,200,201,202,210,211,212,213,214,215,216,217,218,225,226,227,228,229,230,231,232,233,234,241,242,243,244,245,246,247,248,249,250],N=[0,0,3,1,1,1,1,1,1,1,1,1,0,0,0,0,0],Q=[0,1,2,3,4,5,6,7,8,9,10,11],F=[0,0,2,1,2,4,4,3,4,7,5,4,4,0,1,2,119],U=[0,1,2,3,17,4,5,33,49,6,18,65,81,7,97,113,19,34,50,129,8,20,66,145,161,177,193,9,35,51,82,240,21,98,114,209,10,22,36,52,225,37,241,23,24,25,26,38,39,40,41,42,53,54,55,56,57,58,67,68,69,70,71,72,73,74,83,84,85,86,87,88,89,90,99,100,101,102,103,104,105,106,115,116,117,118,119,120,121,122,130,131,132,133,134,135,136,137,138,146,147,148,149,150,151,152,153,154,162,163,164,165,166,167,168,169,170,178,179,180,181,182,183,184,185,186,194,195,196,197,198,199,200,201,202,210,211,212,213,214,215,216,217,218,226,227,228,229,230,231,232,233,234,242,243,244,245,246,247,248,249,250];function S(e,t){for(var r=0,n=0,o=new Array,s=1;s<=16;s++){for(var i=1;i<=e[s];i++)o[t[n]]=[],o[t[n]][0]=r,o[t[n]][1]=s,n++,r++;r*=2}return o}function L(e){for(var t=e[0],r=e[1]-1;r>=0;)t&1<<r&&(m|=1<<g),r--,--g<0&&(255==m?(T(255),T(0)):T(m),g=7,m=0)}function T(e){p.push(e)}function H(e){T(e>>8&255),T(255&e)}function I(e,t,r,n,o){for(var s,i=o[0],a=o[240],A=function(e,t){var r,n,o,s,i,a,A,u,c,l,d=0;for(c=0;c<8;++c){r=e[d],n=e[d+1],o=e[d+2],s=e[d+3],i=e[d+4],a=e[d+5],A=e[d+6];var h=r+(u=e[d+7]),p=r-u,m=n+A,g=n-A,y=o+a,v=o-a,w=s+i,b=s-i,B=h+w,j=h-w,_=m+y,C=m-y;e[d]=B+_,e[d+4]=B-_;var x=.707106781*(C+j);e[d+2]=j+x,e[d+6]=j-x;var E=.382683433*((B=b+v)-(C=g+p)),N=.5411961*B+E,Q=1.306562965*C+E,F=.707106781*(_=v+g),U=p+F,S=p-F;e[d+5]=S+N,e[d+3]=S-N,e[d+1]=U+Q,e[d+7]=U-Q,d+=8}for(d=0,c=0;c<8;++c){r=e[d],n=e[d+8],o=e[d+16],s=e[d+24],i=e[d+32],a=e[d+40],A=e[d+48];var L=r+(u=e[d+56]),T=r-u,H=n+A,I=n-A,P=o+a,O=o-a,k=s+i,R=s-i,M=L+k,D=L-k,K=H+P,z=H-P;e[d]=M+K,e[d+32]=M-K;var V=.707106781*(z+D);e[d+16]=D+V,e[d+48]=D-V;var q=.382683433*((M=R+O)-(z=I+T)),G=.5411961*M+q,X=1.306562965*z+q,W=.707106781*(K=O+I),J=T+W,Y=T-W;e[d+40]=Y+G,e[d+24]=Y-G,e[d+8]=J+X,e[d+56]=J-X,d++}for(c=0;c<64;++c)l=e[c]*t[c],f[c]=l>0?l+.5|0:l-.5|0;return f}(e,t),u=0;u<64;++u)h[j[u]]=A[u];var c=h[0]-r;r=h[0],0==c?L(n[0]):(L(n[d[s=32767+c]]),L(l[s]));for(var p=63;p>0&&0==h[p];)p--;if(0==p)return L(i),r;for(var m,g=1;g<=p;){for(var y=g;0==h[g]&&g<=p;)++g;var v=g-y;if(v>=16){m=v>>4;for(var w=1;w<=m;++w)L(a);v&=15}s=32767+h[g],L(o[(v<<4)+d[s]]),L(l[s]),g++}return 63!=p&&L(i),r}function P(e){e=Math.min(Math.max(e,1),100),s!=e&&(function(e){for(var t=[16,11,10,16,24,40,51,61,12,12,14,19,26,58,60,55,14,13,16,24,40,57,69,56,14,17,22,29,51,87,80,62,18,22,37,56,68,109,103,77,24,35,55,64,81,104,113,92,49,64,78,87,103,121,120,101,72,92,95,98,112,100,103,99],r=0;r<64;r++){var n=i((t[r]*e+50)/100);n=Math.min(Math.max(n,1),255),a[j[r]]=n}for(var o=[17,18,24,47,99,99,99,99,18,21,26,66,99,99,99,99,24,26,56,99,99,99,99,99,47,66,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99,99],s=0;s<64;s++){var l=i((o[s]*e+50)/100);l=Math.min(Math.max(l,1),255),A[j[s]]=l}for(var d=[1,1.387039845,1.306562965,1.175875602,1,.785694958,.5411961,.275899379],f=0,h=0;h<8;h++)for(var p=0;p<8;p++)u[f]=1/(a[j[f]]*d[h]*d[p]*8),c[f]=1/(A[j[f]]*d[h]*d[p]*8),f++}(e<50?Math.floor(5e3/e):Math.floor(200-2*e)),s=e)}this.encode=function(e,s){s&&P(s),p=new Array,m=0,g=7,H(65496),H(65504),H(16),T(74),T(70),T(73),T(70),T(0),T(1),T(1),T(0),H(1),H(1),T(0),T(0),function(){H(65499),H(132),T(0);for(var e=0;e<64;e++)T(a[e]);T(1);for(var t=0;t<64;t++)T(A[t])}(),function(e,t){H(65472),H(17),T(8),H(t),H(e),T(3),T(1),T(17),T(0),T(2),T(17),T(1),T(3),T(17),T(1)}(e.width,e.height),function(){H(65476),H(418),T(0);for(var e=0;e<16;e++)T(_[e+1]);for(var t=0;t<=11;t++)T(C[t]);T(16);for(var r=0;r<16;r++)T(x[r+1]);for(var n=0;n<=161;n++)T(E[n]);T(1);for(var o=0;o<16;o++)T(N[o+1]);for(var s=0;s<=11;s++)T(Q[s]);T(17);for(var i=0;i<16;i++)T(F[i+1]);for(var a=0;a<=161;a++)T(U[a])}(),H(65498),H(12),T(3),T(1),T(0),T(2),T(17),T(3),T(17),T(0),T(63),T(0);var i=0,l=0,d=0;m=0,g=7,this.encode.displayName="_encode_";for(var f,h,b,j,S,O,k,R,M,D=e.data,K=e.width,z=e.height,V=4*K,q=0;q<z;){for(f=0;f<V;){for(S=V*q+f,k=-1,R=0,M=0;M<64;M++)O=S+(R=M>>3)*V+(k=4*(7&M)),q+R>=z&&(O-=V*(q+1+R-z)),f+k>=V&&(O-=f+k-V+4),h=D[O++],b=D[O++],j=D[O++],y[M]=(B[h]+B[b+256>>0]+B[j+512>>0]>>16)-128,v[M]=(B[h+768>>0]+B[b+1024>>0]+B[j+1280>>0]>>16)-128,w[M]=(B[h+1280>>0]+B[b+1536>>0]+B[j+1792>>0]>>16)-128;i=I(y,u,i,t,n),l=I(v,c,l,r,o),d=I(w,c,d,r,o),f+=32}q+=8}if(g>=0){var G=[];G[1]=g+1,G[0]=(1<<g+1)-1,L(G)}return H(65497),new Uint8Array(p)},e=e||50,function(){for(var e=String.fromCharCode,t=0;t<256;t++)b[t]=e(t)}(),t=S(_,C),r=S(N,Q),n=S(x,E),o=S(F,U),function(){for(var e=1,t=2,r=1;r<=15;r++){for(var n=e;n<t;n++)d[32767+n]=r,l[32767+n]=[],l[32767+n][1]=r,l[32767+n][0]=n;for(var o=-(t-1);o<=-e;o++)d[32767+o]=r,l[32767+o]=[],l[32767+o][1]=r,l[32767+o][0]=t-1+o;e<<=1,t<<=1}}(),function(){for(var e=0;e<256;e++)B[e]=19595*e,B[e+256>>0]=38470*e,B[e+512>>0]=7471*e+32768,B[e+768>>0]=-11059*e,B[e+1024>>0]=-21709*e,B[e+1280>>0]=32768*e+8421375,B[e+1536>>0]=-27439*e,B[e+1792>>0]=-5329*e}(),P(e)}function Ze(e,t){if(this.pos=0,this.buffer=e,this.datav=new DataView(e.buffer),this.is_with_alpha=!!t,this.bottom_up=!0,this.flag=String.fromCharCode(this.buffer[0])+String.fromCharCode(this.buffer[1]),this.pos+=2,-1===["BM","BA","CI","CP","IC","PT"].indexOf(this.flag))throw new Error("Invalid BMP File");this.parseHeader(),this.parseBGR()}function $e(e){function t(e){if(!e)throw Error("assert :P")}function r(e,t,r){for(var n=0;4>n;n++)if(e[t+n]!=r.charCodeAt(n))return!0;return!1}function n(e,t,r,n,o){for(var s=0;s<o;s++)e[t+s]=r[n+s]}function o(e,t,r,n){for(var o=0;o<n;o++)e[t+o]=r}function s(e){return new Int32Array(e)}function i(e,t){for(var r=[],n=0;n<e;n++)r.push(new t);return r}function a(e,t){var r=[];return function e(r,n,o){for(var s=o[n],i=0;i<s&&(r.push(o.length>n+1?[]:new t),!(o.length<n+1));i++)e(r[i],n+1,o)}(r,0,e),r}function A(e,t){for(var r="",n=0;n<4;n++)r+=String.fromCharCode(e[t++]);return r}function u(e,t){return(e[t+0]<<0|e[t+1]<<8|e[t+2]<<16)>>>0}function c(e,t){return(e[t+0]<<0|e[t+1]<<8|e[t+2]<<16|e[t+3]<<24)>>>0}new($e=function(){var e=this;function A(e,t){for(var r=1<<t-1>>>0;e&r;)r>>>=1;return r?(e&r-1)+r:e}function u(e,r,n,o,s){t(!(o%n));do{e[r+(o-=n)]=s}while(0<o)}function c(e,r,n,o,i){if(t(2328>=i),512>=i)var a=s(512);else if(null==(a=s(i)))return 0;return function(e,r,n,o,i,a){var c,d,f=r,h=1<<n,p=s(16),m=s(16);for(t(0!=i),t(null!=o),t(null!=e),t(0<n),d=0;d<i;++d){if(15<o[d])return 0;++p[o[d]]}if(p[0]==i)return 0;for(m[1]=0,c=1;15>c;++c){if(p[c]>1<<c)return 0;m[c+1]=m[c]+p[c]}for(d=0;d<i;++d)c=o[d],0<o[d]&&(a[m[c]++]=d);if(1==m[15])return(o=new l).g=0,o.value=a[0],u(e,f,1,h,o),h;var g,y=-1,v=h-1,w=0,b=1,B=1,j=1<<n;for(d=0,c=1,i=2;c<=n;++c,i<<=1){if(b+=B<<=1,0>(B-=p[c]))return 0;for(;0<p[c];--p[c])(o=new l).g=c,o.value=a[d++],u(e,f+w,i,j,o),w=A(w,c)}for(c=n+1,i=2;15>=c;++c,i<<=1){if(b+=B<<=1,0>(B-=p[c]))return 0;for(;0<p[c];--p[c]){if(o=new l,(w&v)!=y){for(f+=j,g=1<<(y=c)-n;15>y&&!(0>=(g-=p[y]));)++y,g<<=1;h+=j=1<<(g=y-n),e[r+(y=w&v)].g=g+n,e[r+y].value=f-r-y}o.g=c-n,o.value=a[d++],u(e,f+(w>>n),i,j,o),w=A(w,c)}}return b!=2*m[15]-1?0:h}(e,r,n,o,i,a)}function l(){this.value=this.g=0}function d(){this.value=this.g=0}function f(){this.G=i(5,l),this.H=s(5),this.jc=this.Qb=this.qb=this.nd=0,this.pd=i(Or,d)}function h(e,r,n,o){t(null!=e),t(null!=r),t(2147483648>o),e.Ca=254,e.I=0,e.b=-8,e.Ka=0,e.oa=r,e.pa=n,e.Jd=r,e.Yc=n+o,e.Zc=4<=o?n+o-4+1:n,x(e)}function p(e,t){for(var r=0;0<t--;)r|=N(e,128)<<t;return r}function m(e,t){var r=p(e,t);return E(e)?-r:r}function g(e,r,n,o){var s,i=0;for(t(null!=e),t(null!=r),t(4294967288>o),e.Sb=o,e.Ra=0,e.u=0,e.h=0,4<o&&(o=4),s=0;s<o;++s)i+=r[n+s]<<8*s;e.Ra=i,e.bb=o,e.oa=r,e.pa=n}function y(e){for(;8<=e.u&&e.bb<e.Sb;)e.Ra>>>=8,e.Ra+=e.oa[e.pa+e.bb]<<Mr-8>>>0,++e.bb,e.u-=8;j(e)&&(e.h=1,e.u=0)}function v(e,r){if(t(0<=r),!e.h&&r<=Rr){var n=B(e)&kr[r];return e.u+=r,y(e),n}return e.h=1,e.u=0}function w(){this.b=this.Ca=this.I=0,this.oa=[],this.pa=0,this.Jd=[],this.Yc=0,this.Zc=[],this.Ka=0}function b(){this.Ra=0,this.oa=[],this.h=this.u=this.bb=this.Sb=this.pa=0}function B(e){return e.Ra>>>(e.u&Mr-1)>>>0}function j(e){return t(e.bb<=e.Sb),e.h||e.bb==e.Sb&&e.u>Mr}function _(e,t){e.u=t,e.h=j(e)}function C(e){e.u>=Dr&&(t(e.u>=Dr),y(e))}function x(e){t(null!=e&&null!=e.oa),e.pa<e.Zc?(e.I=(e.oa[e.pa++]|e.I<<8)>>>0,e.b+=8):(t(null!=e&&null!=e.oa),e.pa<e.Yc?(e.b+=8,e.I=e.oa[e.pa++]|e.I<<8):e.Ka?e.b=0:(e.I<<=8,e.b+=8,e.Ka=1))}function E(e){return p(e,1)}function N(e,t){var r=e.Ca;0>e.b&&x(e);var n=e.b,o=r*t>>>8,s=(e.I>>>n>o)+0;for(s?(r-=o,e.I-=o+1<<n>>>0):r=o+1,n=r,o=0;256<=n;)o+=8,n>>=8;return n=7^o+Kr[n],e.b-=n,e.Ca=(r<<n)-1,s}function Q(e,t,r){e[t+0]=r>>24&255,e[t+1]=r>>16&255,e[t+2]=r>>8&255,e[t+3]=r>>0&255}function F(e,t){return e[t+0]<<0|e[t+1]<<8}function U(e,t){return F(e,t)|e[t+2]<<16}function S(e,t){return F(e,t)|F(e,t+2)<<16}function L(e,r){var n=1<<r;return t(null!=e),t(0<r),e.X=s(n),null==e.X?0:(e.Mb=32-r,e.Xa=r,1)}function T(e,r){t(null!=e),t(null!=r),t(e.Xa==r.Xa),n(r.X,0,e.X,0,1<<r.Xa)}function H(){this.X=[],this.Xa=this.Mb=0}function I(e,r,n,o){t(null!=n),t(null!=o);var s=n[0],i=o[0];return 0==s&&(s=(e*i+r/2)/r),0==i&&(i=(r*s+e/2)/e),0>=s||0>=i?0:(n[0]=s,o[0]=i,1)}function P(e,t){return e+(1<<t)-1>>>t}function O(e,t){return((4278255360&e)+(4278255360&t)>>>0&4278255360)+((16711935&e)+(16711935&t)>>>0&16711935)>>>0}function k(t,r){e[r]=function(r,n,o,s,i,a,A){var u;for(u=0;u<i;++u){var c=e[t](a[A+u-1],o,s+u);a[A+u]=O(r[n+u],c)}}}function R(){this.ud=this.hd=this.jd=0}function M(e,t){return((4278124286&(e^t))>>>1)+(e&t)>>>0}function D(e){return 0<=e&&256>e?e:0>e?0:255<e?255:void 0}function K(e,t){return D(e+(e-t+.5>>1))}function z(e,t,r){return Math.abs(t-r)-Math.abs(e-r)}function V(e,t,r,n,o,s,i){for(n=s[i-1],r=0;r<o;++r)s[i+r]=n=O(e[t+r],n)}function q(e,t,r,n,o){var s;for(s=0;s<r;++s){var i=e[t+s],a=i>>8&255,A=16711935&(A=(A=16711935&i)+((a<<16)+a));n[o+s]=(4278255360&i)+A>>>0}}function G(e,t){t.jd=e>>0&255,t.hd=e>>8&255,t.ud=e>>16&255}function X(e,t,r,n,o,s){var i;for(i=0;i<n;++i){var a=t[r+i],A=a>>>8,u=a,c=255&(c=(c=a>>>16)+((e.jd<<24>>24)*(A<<24>>24)>>>5));u=255&(u=(u+=(e.hd<<24>>24)*(A<<24>>24)>>>5)+((e.ud<<24>>24)*(c<<24>>24)>>>5)),o[s+i]=(4278255360&a)+(c<<16)+u}}function W(t,r,n,o,s){e[r]=function(e,t,r,n,i,a,A,u,c){for(n=A;n<u;++n)for(A=0;A<c;++A)i[a++]=s(r[o(e[t++])])},e[t]=function(t,r,i,a,A,u,c){var l=8>>t.b,d=t.Ea,f=t.K[0],h=t.w;if(8>l)for(t=(1<<t.b)-1,h=(1<<l)-1;r<i;++r){var p,m=0;for(p=0;p<d;++p)p&t||(m=o(a[A++])),u[c++]=s(f[m&h]),m>>=l}else e["VP8LMapColor"+n](a,A,f,h,u,c,r,i,d)}}function J(e,t,r,n,o){for(r=t+r;t<r;){var s=e[t++];n[o++]=s>>16&255,n[o++]=s>>8&255,n[o++]=s>>0&255}}function Y(e,t,r,n,o){for(r=t+r;t<r;){var s=e[t++];n[o++]=s>>16&255,n[o++]=s>>8&255,n[o++]=s>>0&255,n[o++]=s>>24&255}}function Z(e,t,r,n,o){for(r=t+r;t<r;){var s=(i=e[t++])>>16&240|i>>12&15,i=i>>0&240|i>>28&15;n[o++]=s,n[o++]=i}}function $(e,t,r,n,o){for(r=t+r;t<r;){var s=(i=e[t++])>>16&248|i>>13&7,i=i>>5&224|i>>3&31;n[o++]=s,n[o++]=i}}function ee(e,t,r,n,o){for(r=t+r;t<r;){var s=e[t++];n[o++]=s>>0&255,n[o++]=s>>8&255,n[o++]=s>>16&255}}function te(e,t,r,o,s,i){if(0==i)for(r=t+r;t<r;)Q(o,((i=e[t++])[0]>>24|i[1]>>8&65280|i[2]<<8&16711680|i[3]<<24)>>>0),s+=32;else n(o,s,e,t,r)}function re(t,r){e[r][0]=e[t+"0"],e[r][1]=e[t+"1"],e[r][2]=e[t+"2"],e[r][3]=e[t+"3"],e[r][4]=e[t+"4"],e[r][5]=e[t+"5"],e[r][6]=e[t+"6"],e[r][7]=e[t+"7"],e[r][8]=e[t+"8"],e[r][9]=e[t+"9"],e[r][10]=e[t+"10"],e[r][11]=e[t+"11"],e[r][12]=e[t+"12"],e[r][13]=e[t+"13"],e[r][14]=e[t+"0"],e[r][15]=e[t+"0"]}function ne(e){return e==Kn||e==zn||e==Vn||e==qn}function oe(){this.eb=[],this.size=this.A=this.fb=0}function se(){this.y=[],this.f=[],this.ea=[],this.F=[],this.Tc=this.Ed=this.Cd=this.Fd=this.lb=this.Db=this.Ab=this.fa=this.J=this.W=this.N=this.O=0}function ie(){this.Rd=this.height=this.width=this.S=0,this.f={},this.f.RGBA=new oe,this.f.kb=new se,this.sd=null}function ae(){this.width=[0],this.height=[0],this.Pd=[0],this.Qd=[0],this.format=[0]}function Ae(){this.Id=this.fd=this.Md=this.hb=this.ib=this.da=this.bd=this.cd=this.j=this.v=this.Da=this.Sd=this.ob=0}function ue(e){return alert("todo:WebPSamplerProcessPlane"),e.T}function ce(e,t){var r=e.T,o=t.ba.f.RGBA,s=o.eb,i=o.fb+e.ka*o.A,a=yo[t.ba.S],A=e.y,u=e.O,c=e.f,l=e.N,d=e.ea,f=e.W,h=t.cc,p=t.dc,m=t.Mc,g=t.Nc,y=e.ka,v=e.ka+e.T,w=e.U,b=w+1>>1;for(0==y?a(A,u,null,null,c,l,d,f,c,l,d,f,s,i,null,null,w):(a(t.ec,t.fc,A,u,h,p,m,g,c,l,d,f,s,i-o.A,s,i,w),++r);y+2<v;y+=2)h=c,p=l,m=d,g=f,l+=e.Rc,f+=e.Rc,i+=2*o.A,a(A,(u+=2*e.fa)-e.fa,A,u,h,p,m,g,c,l,d,f,s,i-o.A,s,i,w);return u+=e.fa,e.j+v<e.o?(n(t.ec,t.fc,A,u,w),n(t.cc,t.dc,c,l,b),n(t.Mc,t.Nc,d,f,b),r--):1&v||a(A,u,null,null,c,l,d,f,c,l,d,f,s,i+o.A,null,null,w),r}function le(e,r,n){var o=e.F,s=[e.J];if(null!=o){var i=e.U,a=r.ba.S,A=a==Rn||a==Vn;r=r.ba.f.RGBA;var u=[0],c=e.ka;u[0]=e.T,e.Kb&&(0==c?--u[0]:(--c,s[0]-=e.width),e.j+e.ka+e.T==e.o&&(u[0]=e.o-e.j-c));var l=r.eb;c=r.fb+c*r.A,e=Cn(o,s[0],e.width,i,u,l,c+(A?0:3),r.A),t(n==u),e&&ne(a)&&jn(l,c,A,i,u,r.A)}return 0}function de(e){var t=e.ma,r=t.ba.S,n=11>r,o=r==Pn||r==kn||r==Rn||r==Mn||12==r||ne(r);if(t.memory=null,t.Ib=null,t.Jb=null,t.Nd=null,!Hr(t.Oa,e,o?11:12))return 0;if(o&&ne(r)&&yr(),e.da)alert("todo:use_scaling");else{if(n){if(t.Ib=ue,e.Kb){if(r=e.U+1>>1,t.memory=s(e.U+2*r),null==t.memory)return 0;t.ec=t.memory,t.fc=0,t.cc=t.ec,t.dc=t.fc+e.U,t.Mc=t.cc,t.Nc=t.dc+r,t.Ib=ce,yr()}}else alert("todo:EmitYUV");o&&(t.Jb=le,n&&mr())}if(n&&!So){for(e=0;256>e;++e)Lo[e]=89858*(e-128)+Eo>>xo,Io[e]=-22014*(e-128)+Eo,Ho[e]=-45773*(e-128),To[e]=113618*(e-128)+Eo>>xo;for(e=No;e<Qo;++e)t=76283*(e-16)+Eo>>xo,Po[e-No]=Ve(t,255),Oo[e-No]=Ve(t+8>>4,15);So=1}return 1}function fe(e){var r=e.ma,n=e.U,o=e.T;return t(!(1&e.ka)),0>=n||0>=o?0:(n=r.Ib(e,r),null!=r.Jb&&r.Jb(e,r,n),r.Dc+=n,1)}function he(e){e.ma.memory=null}function pe(e,t,r,n){return 47!=v(e,8)?0:(t[0]=v(e,14)+1,r[0]=v(e,14)+1,n[0]=v(e,1),0!=v(e,3)?0:!e.h)}function me(e,t){if(4>e)return e+1;var r=e-2>>1;return(2+(1&e)<<r)+v(t,r)+1}function ge(e,t){return 120<t?t-120:1<=(r=((r=Zn[t-1])>>4)*e+(8-(15&r)))?r:1;var r}function ye(e,t,r){var n=B(r),o=e[t+=255&n].g-8;return 0<o&&(_(r,r.u+8),n=B(r),t+=e[t].value,t+=n&(1<<o)-1),_(r,r.u+e[t].g),e[t].value}function ve(e,r,n){return n.g+=e.g,n.value+=e.value<<r>>>0,t(8>=n.g),e.g}function we(e,r,n){var o=e.xc;return t((r=0==o?0:e.vc[e.md*(n>>o)+(r>>o)])<e.Wb),e.Ya[r]}function be(e,r,o,s){var i=e.ab,a=e.c*r,A=e.C;r=A+r;var u=o,c=s;for(s=e.Ta,o=e.Ua;0<i--;){var l=e.gc[i],d=A,f=r,h=u,p=c,m=(c=s,u=o,l.Ea);switch(t(d<f),t(f<=l.nc),l.hc){case 2:qr(h,p,(f-d)*m,c,u);break;case 0:var g=d,y=f,v=c,w=u,b=(x=l).Ea;0==g&&(zr(h,p,null,null,1,v,w),V(h,p+1,0,0,b-1,v,w+1),p+=b,w+=b,++g);for(var B=1<<x.b,j=B-1,_=P(b,x.b),C=x.K,x=x.w+(g>>x.b)*_;g<y;){var E=C,N=x,Q=1;for(Vr(h,p,v,w-b,1,v,w);Q<b;){var F=(Q&~j)+B;F>b&&(F=b),(0,Yr[E[N++]>>8&15])(h,p+ +Q,v,w+Q-b,F-Q,v,w+Q),Q=F}p+=b,w+=b,++g&j||(x+=_)}f!=l.nc&&n(c,u-m,c,u+(f-d-1)*m,m);break;case 1:for(m=h,y=p,b=(h=l.Ea)-(w=h&~(v=(p=1<<l.b)-1)),g=P(h,l.b),B=l.K,l=l.w+(d>>l.b)*g;d<f;){for(j=B,_=l,C=new R,x=y+w,E=y+h;y<x;)G(j[_++],C),Zr(C,m,y,p,c,u),y+=p,u+=p;y<E&&(G(j[_++],C),Zr(C,m,y,b,c,u),y+=b,u+=b),++d&v||(l+=g)}break;case 3:if(h==c&&p==u&&0<l.b){for(y=c,h=m=u+(f-d)*m-(w=(f-d)*P(l.Ea,l.b)),p=c,v=u,g=[],w=(b=w)-1;0<=w;--w)g[w]=p[v+w];for(w=b-1;0<=w;--w)y[h+w]=g[w];Gr(l,d,f,c,m,c,u)}else Gr(l,d,f,h,p,c,u)}u=s,c=o}c!=o&&n(s,o,u,c,a)}function Be(e,r){var n=e.V,o=e.Ba+e.c*e.C,s=r-e.C;if(t(r<=e.l.o),t(16>=s),0<s){var i=e.l,a=e.Ta,A=e.Ua,u=i.width;if(be(e,s,n,o),s=A=[A],t((n=e.C)<(o=r)),t(i.v<i.va),o>i.o&&(o=i.o),n<i.j){var c=i.j-n;n=i.j,s[0]+=c*u}if(n>=o?n=0:(s[0]+=4*i.v,i.ka=n-i.j,i.U=i.va-i.v,i.T=o-n,n=1),n){if(A=A[0],11>(n=e.ca).S){var l=n.f.RGBA,d=(o=n.S,s=i.U,i=i.T,c=l.eb,l.A),f=i;for(l=l.fb+e.Ma*l.A;0<f--;){var h=a,p=A,m=s,g=c,y=l;switch(o){case In:$r(h,p,m,g,y);break;case Pn:en(h,p,m,g,y);break;case Kn:en(h,p,m,g,y),jn(g,y,0,m,1,0);break;case On:nn(h,p,m,g,y);break;case kn:te(h,p,m,g,y,1);break;case zn:te(h,p,m,g,y,1),jn(g,y,0,m,1,0);break;case Rn:te(h,p,m,g,y,0);break;case Vn:te(h,p,m,g,y,0),jn(g,y,1,m,1,0);break;case Mn:tn(h,p,m,g,y);break;case qn:tn(h,p,m,g,y),_n(g,y,m,1,0);break;case Dn:rn(h,p,m,g,y);break;default:t(0)}A+=u,l+=d}e.Ma+=i}else alert("todo:EmitRescaledRowsYUVA");t(e.Ma<=n.height)}}e.C=r,t(e.C<=e.i)}function je(e){var t;if(0<e.ua)return 0;for(t=0;t<e.Wb;++t){var r=e.Ya[t].G,n=e.Ya[t].H;if(0<r[1][n[1]+0].g||0<r[2][n[2]+0].g||0<r[3][n[3]+0].g)return 0}return 1}function _e(e,r,n,o,s,i){if(0!=e.Z){var a=e.qd,A=e.rd;for(t(null!=go[e.Z]);r<n;++r)go[e.Z](a,A,o,s,o,s,i),a=o,A=s,s+=i;e.qd=a,e.rd=A}}function Ce(e,r){var n=e.l.ma,o=0==n.Z||1==n.Z?e.l.j:e.C;if(o=e.C<o?o:e.C,t(r<=e.l.o),r>o){var s=e.l.width,i=n.ca,a=n.tb+s*o,A=e.V,u=e.Ba+e.c*o,c=e.gc;t(1==e.ab),t(3==c[0].hc),Wr(c[0],o,r,A,u,i,a),_e(n,o,r,i,a,s)}e.C=e.Ma=r}function xe(e,r,n,o,s,i,a){var A=e.$/o,u=e.$%o,c=e.m,l=e.s,d=n+e.$,f=d;s=n+o*s;var h=n+o*i,p=280+l.ua,m=e.Pb?A:16777216,g=0<l.ua?l.Wa:null,y=l.wc,v=d<h?we(l,u,A):null;t(e.C<i),t(h<=s);var w=!1;e:for(;;){for(;w||d<h;){var b=0;if(A>=m){var x=d-n;t((m=e).Pb),m.wd=m.m,m.xd=x,0<m.s.ua&&T(m.s.Wa,m.s.vb),m=A+eo}if(u&y||(v=we(l,u,A)),t(null!=v),v.Qb&&(r[d]=v.qb,w=!0),!w)if(C(c),v.jc){b=c,x=r;var E=d,N=v.pd[B(b)&Or-1];t(v.jc),256>N.g?(_(b,b.u+N.g),x[E]=N.value,b=0):(_(b,b.u+N.g-256),t(256<=N.value),b=N.value),0==b&&(w=!0)}else b=ye(v.G[0],v.H[0],c);if(c.h)break;if(w||256>b){if(!w)if(v.nd)r[d]=(v.qb|b<<8)>>>0;else{if(C(c),w=ye(v.G[1],v.H[1],c),C(c),x=ye(v.G[2],v.H[2],c),E=ye(v.G[3],v.H[3],c),c.h)break;r[d]=(E<<24|w<<16|b<<8|x)>>>0}if(w=!1,++d,++u>=o&&(u=0,++A,null!=a&&A<=i&&!(A%16)&&a(e,A),null!=g))for(;f<d;)b=r[f++],g.X[(506832829*b&4294967295)>>>g.Mb]=b}else if(280>b){if(b=me(b-256,c),x=ye(v.G[4],v.H[4],c),C(c),x=ge(o,x=me(x,c)),c.h)break;if(d-n<x||s-d<b)break e;for(E=0;E<b;++E)r[d+E]=r[d+E-x];for(d+=b,u+=b;u>=o;)u-=o,++A,null!=a&&A<=i&&!(A%16)&&a(e,A);if(t(d<=s),u&y&&(v=we(l,u,A)),null!=g)for(;f<d;)b=r[f++],g.X[(506832829*b&4294967295)>>>g.Mb]=b}else{if(!(b<p))break e;for(w=b-280,t(null!=g);f<d;)b=r[f++],g.X[(506832829*b&4294967295)>>>g.Mb]=b;b=d,t(!(w>>>(x=g).Xa)),r[b]=x.X[w],w=!0}w||t(c.h==j(c))}if(e.Pb&&c.h&&d<s)t(e.m.h),e.a=5,e.m=e.wd,e.$=e.xd,0<e.s.ua&&T(e.s.vb,e.s.Wa);else{if(c.h)break e;null!=a&&a(e,A>i?i:A),e.a=0,e.$=d-n}return 1}return e.a=3,0}function Ee(e){t(null!=e),e.vc=null,e.yc=null,e.Ya=null;var r=e.Wa;null!=r&&(r.X=null),e.vb=null,t(null!=e)}function Ne(){var t=new ir;return null==t?null:(t.a=0,t.xb=mo,re("Predictor","VP8LPredictors"),re("Predictor","VP8LPredictors_C"),re("PredictorAdd","VP8LPredictorsAdd"),re("PredictorAdd","VP8LPredictorsAdd_C"),qr=q,Zr=X,$r=J,en=Y,tn=Z,rn=$,nn=ee,e.VP8LMapColor32b=Xr,e.VP8LMapColor8b=Jr,t)}function Qe(e,r,n,a,A){var u=1,d=[e],h=[r],p=a.m,m=a.s,g=null,y=0;e:for(;;){if(n)for(;u&&v(p,1);){var w=d,b=h,j=a,x=1,E=j.m,N=j.gc[j.ab],Q=v(E,2);if(j.Oc&1<<Q)u=0;else{switch(j.Oc|=1<<Q,N.hc=Q,N.Ea=w[0],N.nc=b[0],N.K=[null],++j.ab,t(4>=j.ab),Q){case 0:case 1:N.b=v(E,3)+2,x=Qe(P(N.Ea,N.b),P(N.nc,N.b),0,j,N.K),N.K=N.K[0];break;case 3:var F,U=v(E,8)+1,S=16<U?0:4<U?1:2<U?2:3;if(w[0]=P(N.Ea,S),N.b=S,F=x=Qe(U,1,0,j,N.K)){var T,H=U,I=N,k=1<<(8>>I.b),R=s(k);if(null==R)F=0;else{var M=I.K[0],D=I.w;for(R[0]=I.K[0][0],T=1;T<1*H;++T)R[T]=O(M[D+T],R[T-1]);for(;T<4*k;++T)R[T]=0;I.K[0]=null,I.K[0]=R,F=1}}x=F;break;case 2:break;default:t(0)}u=x}}if(d=d[0],h=h[0],u&&v(p,1)&&!(u=1<=(y=v(p,4))&&11>=y)){a.a=3;break e}var K;if(K=u)t:{var z,V,q,G=a,X=d,W=h,J=y,Y=n,Z=G.m,$=G.s,ee=[null],te=1,re=0,ne=$n[J];r:for(;;){if(Y&&v(Z,1)){var oe=v(Z,3)+2,se=P(X,oe),ie=P(W,oe),ae=se*ie;if(!Qe(se,ie,0,G,ee))break r;for(ee=ee[0],$.xc=oe,z=0;z<ae;++z){var Ae=ee[z]>>8&65535;ee[z]=Ae,Ae>=te&&(te=Ae+1)}}if(Z.h)break r;for(V=0;5>V;++V){var ue=Wn[V];!V&&0<J&&(ue+=1<<J),re<ue&&(re=ue)}var ce=i(te*ne,l),le=te,de=i(le,f);if(null==de)var fe=null;else t(65536>=le),fe=de;var he=s(re);if(null==fe||null==he||null==ce){G.a=1;break r}var pe=ce;for(z=q=0;z<te;++z){var me=fe[z],ge=me.G,ye=me.H,we=0,be=1,Be=0;for(V=0;5>V;++V){ue=Wn[V],ge[V]=pe,ye[V]=q,!V&&0<J&&(ue+=1<<J);n:{var je,_e=ue,Ce=G,Ne=he,Fe=pe,Ue=q,Se=0,Le=Ce.m,Te=v(Le,1);if(o(Ne,0,0,_e),Te){var He=v(Le,1)+1,Ie=v(Le,1),Pe=v(Le,0==Ie?1:8);Ne[Pe]=1,2==He&&(Ne[Pe=v(Le,8)]=1);var Oe=1}else{var ke=s(19),Re=v(Le,4)+4;if(19<Re){Ce.a=3;var Me=0;break n}for(je=0;je<Re;++je)ke[Yn[je]]=v(Le,3);var De=void 0,Ke=void 0,ze=Ce,Ve=ke,qe=_e,Ge=Ne,Xe=0,We=ze.m,Je=8,Ye=i(128,l);o:for(;c(Ye,0,7,Ve,19);){if(v(We,1)){var Ze=2+2*v(We,3);if((De=2+v(We,Ze))>qe)break o}else De=qe;for(Ke=0;Ke<qe&&De--;){C(We);var $e=Ye[0+(127&B(We))];_(We,We.u+$e.g);var et=$e.value;if(16>et)Ge[Ke++]=et,0!=et&&(Je=et);else{var tt=16==et,rt=et-16,nt=Xn[rt],ot=v(We,Gn[rt])+nt;if(Ke+ot>qe)break o;for(var st=tt?Je:0;0<ot--;)Ge[Ke++]=st}}Xe=1;break o}Xe||(ze.a=3),Oe=Xe}(Oe=Oe&&!Le.h)&&(Se=c(Fe,Ue,8,Ne,_e)),Oe&&0!=Se?Me=Se:(Ce.a=3,Me=0)}if(0==Me)break r;if(be&&1==Jn[V]&&(be=0==pe[q].g),we+=pe[q].g,q+=Me,3>=V){var it,at=he[0];for(it=1;it<ue;++it)he[it]>at&&(at=he[it]);Be+=at}}if(me.nd=be,me.Qb=0,be&&(me.qb=(ge[3][ye[3]+0].value<<24|ge[1][ye[1]+0].value<<16|ge[2][ye[2]+0].value)>>>0,0==we&&256>ge[0][ye[0]+0].value&&(me.Qb=1,me.qb+=ge[0][ye[0]+0].value<<8)),me.jc=!me.Qb&&6>Be,me.jc){var At,ut=me;for(At=0;At<Or;++At){var ct=At,lt=ut.pd[ct],dt=ut.G[0][ut.H[0]+ct];256<=dt.value?(lt.g=dt.g+256,lt.value=dt.value):(lt.g=0,lt.value=0,ct>>=ve(dt,8,lt),ct>>=ve(ut.G[1][ut.H[1]+ct],16,lt),ct>>=ve(ut.G[2][ut.H[2]+ct],0,lt),ve(ut.G[3][ut.H[3]+ct],24,lt))}}}$.vc=ee,$.Wb=te,$.Ya=fe,$.yc=ce,K=1;break t}K=0}if(!(u=K)){a.a=3;break e}if(0<y){if(m.ua=1<<y,!L(m.Wa,y)){a.a=1,u=0;break e}}else m.ua=0;var ft=a,ht=d,pt=h,mt=ft.s,gt=mt.xc;if(ft.c=ht,ft.i=pt,mt.md=P(ht,gt),mt.wc=0==gt?-1:(1<<gt)-1,n){a.xb=po;break e}if(null==(g=s(d*h))){a.a=1,u=0;break e}u=(u=xe(a,g,0,d,h,h,null))&&!p.h;break e}return u?(null!=A?A[0]=g:(t(null==g),t(n)),a.$=0,n||Ee(m)):Ee(m),u}function Fe(e,r){var n=e.c*e.i,o=n+r+16*r;return t(e.c<=r),e.V=s(o),null==e.V?(e.Ta=null,e.Ua=0,e.a=1,0):(e.Ta=e.V,e.Ua=e.Ba+n+r,1)}function Ue(e,r){var n=e.C,o=r-n,s=e.V,i=e.Ba+e.c*n;for(t(r<=e.l.o);0<o;){var a=16<o?16:o,A=e.l.ma,u=e.l.width,c=u*a,l=A.ca,d=A.tb+u*n,f=e.Ta,h=e.Ua;be(e,a,s,i),xn(f,h,l,d,c),_e(A,n,n+a,l,d,u),o-=a,s+=a*e.c,n+=a}t(n==r),e.C=e.Ma=r}function Se(){this.ub=this.yd=this.td=this.Rb=0}function Le(){this.Kd=this.Ld=this.Ud=this.Td=this.i=this.c=0}function Te(){this.Fb=this.Bb=this.Cb=0,this.Zb=s(4),this.Lb=s(4)}function He(){this.Yb=function(){var e=[];return function e(t,r,n){for(var o=n[r],s=0;s<o&&(t.push(n.length>r+1?[]:0),!(n.length<r+1));s++)e(t[s],r+1,n)}(e,0,[3,11]),e}()}function Ie(){this.jb=s(3),this.Wc=a([4,8],He),this.Xc=a([4,17],He)}function Pe(){this.Pc=this.wb=this.Tb=this.zd=0,this.vd=new s(4),this.od=new s(4)}function Oe(){this.ld=this.La=this.dd=this.tc=0}function ke(){this.Na=this.la=0}function Re(){this.Sc=[0,0],this.Eb=[0,0],this.Qc=[0,0],this.ia=this.lc=0}function Me(){this.ad=s(384),this.Za=0,this.Ob=s(16),this.$b=this.Ad=this.ia=this.Gc=this.Hc=this.Dd=0}function De(){this.uc=this.M=this.Nb=0,this.wa=Array(new Oe),this.Y=0,this.ya=Array(new Me),this.aa=0,this.l=new qe}function Ke(){this.y=s(16),this.f=s(8),this.ea=s(8)}function ze(){this.cb=this.a=0,this.sc="",this.m=new w,this.Od=new Se,this.Kc=new Le,this.ed=new Pe,this.Qa=new Te,this.Ic=this.$c=this.Aa=0,this.D=new De,this.Xb=this.Va=this.Hb=this.zb=this.yb=this.Ub=this.za=0,this.Jc=i(8,w),this.ia=0,this.pb=i(4,Re),this.Pa=new Ie,this.Bd=this.kc=0,this.Ac=[],this.Bc=0,this.zc=[0,0,0,0],this.Gd=Array(new Ke),this.Hd=0,this.rb=Array(new ke),this.sb=0,this.wa=Array(new Oe),this.Y=0,this.oc=[],this.pc=0,this.sa=[],this.ta=0,this.qa=[],this.ra=0,this.Ha=[],this.B=this.R=this.Ia=0,this.Ec=[],this.M=this.ja=this.Vb=this.Fc=0,this.ya=Array(new Me),this.L=this.aa=0,this.gd=a([4,2],Oe),this.ga=null,this.Fa=[],this.Cc=this.qc=this.P=0,this.Gb=[],this.Uc=0,this.mb=[],this.nb=0,this.rc=[],this.Ga=this.Vc=0}function Ve(e,t){return 0>e?0:e>t?t:e}function qe(){this.T=this.U=this.ka=this.height=this.width=0,this.y=[],this.f=[],this.ea=[],this.Rc=this.fa=this.W=this.N=this.O=0,this.ma="void",this.put="VP8IoPutHook",this.ac="VP8IoSetupHook",this.bc="VP8IoTeardownHook",this.ha=this.Kb=0,this.data=[],this.hb=this.ib=this.da=this.o=this.j=this.va=this.v=this.Da=this.ob=this.w=0,this.F=[],this.J=0}function Ge(){var e=new ze;return null!=e&&(e.a=0,e.sc="OK",e.cb=0,e.Xb=0,no||(no=Ye)),e}function Xe(e,t,r){return 0==e.a&&(e.a=t,e.sc=r,e.cb=0),0}function We(e,t,r){return 3<=r&&157==e[t+0]&&1==e[t+1]&&42==e[t+2]}function Je(e,r){if(null==e)return 0;if(e.a=0,e.sc="OK",null==r)return Xe(e,2,"null VP8Io passed to VP8GetHeaders()");var n=r.data,s=r.w,i=r.ha;if(4>i)return Xe(e,7,"Truncated header.");var a=n[s+0]|n[s+1]<<8|n[s+2]<<16,A=e.Od;if(A.Rb=!(1&a),A.td=a>>1&7,A.yd=a>>4&1,A.ub=a>>5,3<A.td)return Xe(e,3,"Incorrect keyframe parameters.");if(!A.yd)return Xe(e,4,"Frame not displayable.");s+=3,i-=3;var u=e.Kc;if(A.Rb){if(7>i)return Xe(e,7,"cannot parse picture header");if(!We(n,s,i))return Xe(e,3,"Bad code word");u.c=16383&(n[s+4]<<8|n[s+3]),u.Td=n[s+4]>>6,u.i=16383&(n[s+6]<<8|n[s+5]),u.Ud=n[s+6]>>6,s+=7,i-=7,e.za=u.c+15>>4,e.Ub=u.i+15>>4,r.width=u.c,r.height=u.i,r.Da=0,r.j=0,r.v=0,r.va=r.width,r.o=r.height,r.da=0,r.ib=r.width,r.hb=r.height,r.U=r.width,r.T=r.height,o((a=e.Pa).jb,0,255,a.jb.length),t(null!=(a=e.Qa)),a.Cb=0,a.Bb=0,a.Fb=1,o(a.Zb,0,0,a.Zb.length),o(a.Lb,0,0,a.Lb)}if(A.ub>i)return Xe(e,7,"bad partition length");h(a=e.m,n,s,A.ub),s+=A.ub,i-=A.ub,A.Rb&&(u.Ld=E(a),u.Kd=E(a)),u=e.Qa;var c,l=e.Pa;if(t(null!=a),t(null!=u),u.Cb=E(a),u.Cb){if(u.Bb=E(a),E(a)){for(u.Fb=E(a),c=0;4>c;++c)u.Zb[c]=E(a)?m(a,7):0;for(c=0;4>c;++c)u.Lb[c]=E(a)?m(a,6):0}if(u.Bb)for(c=0;3>c;++c)l.jb[c]=E(a)?p(a,8):255}else u.Bb=0;if(a.Ka)return Xe(e,3,"cannot parse segment header");if((u=e.ed).zd=E(a),u.Tb=p(a,6),u.wb=p(a,3),u.Pc=E(a),u.Pc&&E(a)){for(l=0;4>l;++l)E(a)&&(u.vd[l]=m(a,6));for(l=0;4>l;++l)E(a)&&(u.od[l]=m(a,6))}if(e.L=0==u.Tb?0:u.zd?1:2,a.Ka)return Xe(e,3,"cannot parse filter header");var d=i;if(i=c=s,s=c+d,u=d,e.Xb=(1<<p(e.m,2))-1,d<3*(l=e.Xb))n=7;else{for(c+=3*l,u-=3*l,d=0;d<l;++d){var f=n[i+0]|n[i+1]<<8|n[i+2]<<16;f>u&&(f=u),h(e.Jc[+d],n,c,f),c+=f,u-=f,i+=3}h(e.Jc[+l],n,c,u),n=c<s?0:5}if(0!=n)return Xe(e,n,"cannot parse partitions");for(n=p(c=e.m,7),i=E(c)?m(c,4):0,s=E(c)?m(c,4):0,u=E(c)?m(c,4):0,l=E(c)?m(c,4):0,c=E(c)?m(c,4):0,d=e.Qa,f=0;4>f;++f){if(d.Cb){var g=d.Zb[f];d.Fb||(g+=n)}else{if(0<f){e.pb[f]=e.pb[0];continue}g=n}var y=e.pb[f];y.Sc[0]=to[Ve(g+i,127)],y.Sc[1]=ro[Ve(g+0,127)],y.Eb[0]=2*to[Ve(g+s,127)],y.Eb[1]=101581*ro[Ve(g+u,127)]>>16,8>y.Eb[1]&&(y.Eb[1]=8),y.Qc[0]=to[Ve(g+l,117)],y.Qc[1]=ro[Ve(g+c,127)],y.lc=g+c}if(!A.Rb)return Xe(e,4,"Not a key frame.");for(E(a),A=e.Pa,n=0;4>n;++n){for(i=0;8>i;++i)for(s=0;3>s;++s)for(u=0;11>u;++u)l=N(a,uo[n][i][s][u])?p(a,8):ao[n][i][s][u],A.Wc[n][i].Yb[s][u]=l;for(i=0;17>i;++i)A.Xc[n][i]=A.Wc[n][co[i]]}return e.kc=E(a),e.kc&&(e.Bd=p(a,8)),e.cb=1}function Ye(e,t,r,n,o,s,i){var a=t[o].Yb[r];for(r=0;16>o;++o){if(!N(e,a[r+0]))return o;for(;!N(e,a[r+1]);)if(a=t[++o].Yb[0],r=0,16==o)return 16;var A=t[o+1].Yb;if(N(e,a[r+2])){var u=e,c=0;if(N(u,(d=a)[(l=r)+3]))if(N(u,d[l+6])){for(a=0,l=2*(c=N(u,d[l+8]))+(d=N(u,d[l+9+c])),c=0,d=oo[l];d[a];++a)c+=c+N(u,d[a]);c+=3+(8<<l)}else N(u,d[l+7])?(c=7+2*N(u,165),c+=N(u,145)):c=5+N(u,159);else c=N(u,d[l+4])?3+N(u,d[l+5]):2;a=A[2]}else c=1,a=A[1];A=i+so[o],0>(u=e).b&&x(u);var l,d=u.b,f=(l=u.Ca>>1)-(u.I>>d)>>31;--u.b,u.Ca+=f,u.Ca|=1,u.I-=(l+1&f)<<d,s[A]=((c^f)-f)*n[(0<o)+0]}return 16}function Ze(e){var t=e.rb[e.sb-1];t.la=0,t.Na=0,o(e.zc,0,0,e.zc.length),e.ja=0}function $e(e,r){if(null==e)return 0;if(null==r)return Xe(e,2,"NULL VP8Io parameter in VP8Decode().");if(!e.cb&&!Je(e,r))return 0;if(t(e.cb),null==r.ac||r.ac(r)){r.ob&&(e.L=0);var a=Ro[e.L];if(2==e.L?(e.yb=0,e.zb=0):(e.yb=r.v-a>>4,e.zb=r.j-a>>4,0>e.yb&&(e.yb=0),0>e.zb&&(e.zb=0)),e.Va=r.o+15+a>>4,e.Hb=r.va+15+a>>4,e.Hb>e.za&&(e.Hb=e.za),e.Va>e.Ub&&(e.Va=e.Ub),0<e.L){var A=e.ed;for(a=0;4>a;++a){var u;if(e.Qa.Cb){var c=e.Qa.Lb[a];e.Qa.Fb||(c+=A.Tb)}else c=A.Tb;for(u=0;1>=u;++u){var l=e.gd[a][u],d=c;if(A.Pc&&(d+=A.vd[0],u&&(d+=A.od[0])),0<(d=0>d?0:63<d?63:d)){var f=d;0<A.wb&&(f=4<A.wb?f>>2:f>>1)>9-A.wb&&(f=9-A.wb),1>f&&(f=1),l.dd=f,l.tc=2*d+f,l.ld=40<=d?2:15<=d?1:0}else l.tc=0;l.La=u}}}a=0}else Xe(e,6,"Frame setup failed"),a=e.a;if(a=0==a){if(a){e.$c=0,0<e.Aa||(e.Ic=Do);e:{a=e.Ic,A=4*(f=e.za);var h=32*f,p=f+1,m=0<e.L?f*(0<e.Aa?2:1):0,g=(2==e.Aa?2:1)*f;if((l=A+832+(u=3*(16*a+Ro[e.L])/2*h)+(c=null!=e.Fa&&0<e.Fa.length?e.Kc.c*e.Kc.i:0))!=l)a=0;else{if(l>e.Vb){if(e.Vb=0,e.Ec=s(l),e.Fc=0,null==e.Ec){a=Xe(e,1,"no memory during frame initialization.");break e}e.Vb=l}l=e.Ec,d=e.Fc,e.Ac=l,e.Bc=d,d+=A,e.Gd=i(h,Ke),e.Hd=0,e.rb=i(p+1,ke),e.sb=1,e.wa=m?i(m,Oe):null,e.Y=0,e.D.Nb=0,e.D.wa=e.wa,e.D.Y=e.Y,0<e.Aa&&(e.D.Y+=f),t(!0),e.oc=l,e.pc=d,d+=832,e.ya=i(g,Me),e.aa=0,e.D.ya=e.ya,e.D.aa=e.aa,2==e.Aa&&(e.D.aa+=f),e.R=16*f,e.B=8*f,f=(h=Ro[e.L])*e.R,h=h/2*e.B,e.sa=l,e.ta=d+f,e.qa=e.sa,e.ra=e.ta+16*a*e.R+h,e.Ha=e.qa,e.Ia=e.ra+8*a*e.B+h,e.$c=0,d+=u,e.mb=c?l:null,e.nb=c?d:null,t(d+c<=e.Fc+e.Vb),Ze(e),o(e.Ac,e.Bc,0,A),a=1}}if(a){if(r.ka=0,r.y=e.sa,r.O=e.ta,r.f=e.qa,r.N=e.ra,r.ea=e.Ha,r.Vd=e.Ia,r.fa=e.R,r.Rc=e.B,r.F=null,r.J=0,!Un){for(a=-255;255>=a;++a)En[255+a]=0>a?-a:a;for(a=-1020;1020>=a;++a)Nn[1020+a]=-128>a?-128:127<a?127:a;for(a=-112;112>=a;++a)Qn[112+a]=-16>a?-16:15<a?15:a;for(a=-255;510>=a;++a)Fn[255+a]=0>a?0:255<a?255:a;Un=1}on=ut,sn=st,An=it,un=at,cn=At,an=ot,ln=Xt,dn=Wt,fn=Zt,hn=$t,pn=Jt,mn=Yt,gn=er,yn=tr,vn=Dt,wn=Kt,bn=zt,Bn=Vt,fo[0]=_t,fo[1]=lt,fo[2]=Bt,fo[3]=jt,fo[4]=Ct,fo[5]=Et,fo[6]=xt,fo[7]=Nt,fo[8]=Ft,fo[9]=Qt,lo[0]=gt,lo[1]=ft,lo[2]=ht,lo[3]=pt,lo[4]=yt,lo[5]=vt,lo[6]=wt,ho[0]=Tt,ho[1]=dt,ho[2]=Ut,ho[3]=St,ho[4]=It,ho[5]=Ht,ho[6]=Pt,a=1}else a=0}a&&(a=function(e,r){for(e.M=0;e.M<e.Va;++e.M){var i,a=e.Jc[e.M&e.Xb],A=e.m,u=e;for(i=0;i<u.za;++i){var c=A,l=u,d=l.Ac,f=l.Bc+4*i,h=l.zc,p=l.ya[l.aa+i];if(l.Qa.Bb?p.$b=N(c,l.Pa.jb[0])?2+N(c,l.Pa.jb[2]):N(c,l.Pa.jb[1]):p.$b=0,l.kc&&(p.Ad=N(c,l.Bd)),p.Za=!N(c,145)+0,p.Za){var m=p.Ob,g=0;for(l=0;4>l;++l){var y,v=h[0+l];for(y=0;4>y;++y){v=Ao[d[f+y]][v];for(var w=io[N(c,v[0])];0<w;)w=io[2*w+N(c,v[w])];v=-w,d[f+y]=v}n(m,g,d,f,4),g+=4,h[0+l]=v}}else v=N(c,156)?N(c,128)?1:3:N(c,163)?2:0,p.Ob[0]=v,o(d,f,v,4),o(h,0,v,4);p.Dd=N(c,142)?N(c,114)?N(c,183)?1:3:2:0}if(u.m.Ka)return Xe(e,7,"Premature end-of-partition0 encountered.");for(;e.ja<e.za;++e.ja){if(u=a,c=(A=e).rb[A.sb-1],d=A.rb[A.sb+A.ja],i=A.ya[A.aa+A.ja],f=A.kc?i.Ad:0)c.la=d.la=0,i.Za||(c.Na=d.Na=0),i.Hc=0,i.Gc=0,i.ia=0;else{var b,B;if(c=d,d=u,f=A.Pa.Xc,h=A.ya[A.aa+A.ja],p=A.pb[h.$b],l=h.ad,m=0,g=A.rb[A.sb-1],v=y=0,o(l,m,0,384),h.Za)var j=0,_=f[3];else{w=s(16);var C=c.Na+g.Na;if(C=no(d,f[1],C,p.Eb,0,w,0),c.Na=g.Na=(0<C)+0,1<C)on(w,0,l,m);else{var x=w[0]+3>>3;for(w=0;256>w;w+=16)l[m+w]=x}j=1,_=f[0]}var E=15&c.la,Q=15&g.la;for(w=0;4>w;++w){var F=1&Q;for(x=B=0;4>x;++x)E=E>>1|(F=(C=no(d,_,C=F+(1&E),p.Sc,j,l,m))>j)<<7,B=B<<2|(3<C?3:1<C?2:0!=l[m+0]),m+=16;E>>=4,Q=Q>>1|F<<7,y=(y<<8|B)>>>0}for(_=E,j=Q>>4,b=0;4>b;b+=2){for(B=0,E=c.la>>4+b,Q=g.la>>4+b,w=0;2>w;++w){for(F=1&Q,x=0;2>x;++x)C=F+(1&E),E=E>>1|(F=0<(C=no(d,f[2],C,p.Qc,0,l,m)))<<3,B=B<<2|(3<C?3:1<C?2:0!=l[m+0]),m+=16;E>>=2,Q=Q>>1|F<<5}v|=B<<4*b,_|=E<<4<<b,j|=(240&Q)<<b}c.la=_,g.la=j,h.Hc=y,h.Gc=v,h.ia=43690&v?0:p.ia,f=!(y|v)}if(0<A.L&&(A.wa[A.Y+A.ja]=A.gd[i.$b][i.Za],A.wa[A.Y+A.ja].La|=!f),u.Ka)return Xe(e,7,"Premature end-of-file encountered.")}if(Ze(e),A=r,u=1,i=(a=e).D,c=0<a.L&&a.M>=a.zb&&a.M<=a.Va,0==a.Aa)e:{if(i.M=a.M,i.uc=c,Lr(a,i),u=1,i=(B=a.D).Nb,c=(v=Ro[a.L])*a.R,d=v/2*a.B,w=16*i*a.R,x=8*i*a.B,f=a.sa,h=a.ta-c+w,p=a.qa,l=a.ra-d+x,m=a.Ha,g=a.Ia-d+x,Q=0==(E=B.M),y=E>=a.Va-1,2==a.Aa&&Lr(a,B),B.uc)for(F=(C=a).D.M,t(C.D.uc),B=C.yb;B<C.Hb;++B){j=B,_=F;var U=(S=(M=C).D).Nb;b=M.R;var S=S.wa[S.Y+j],L=M.sa,T=M.ta+16*U*b+16*j,H=S.dd,I=S.tc;if(0!=I)if(t(3<=I),1==M.L)0<j&&wn(L,T,b,I+4),S.La&&Bn(L,T,b,I),0<_&&vn(L,T,b,I+4),S.La&&bn(L,T,b,I);else{var P=M.B,O=M.qa,k=M.ra+8*U*P+8*j,R=M.Ha,M=M.Ia+8*U*P+8*j;U=S.ld,0<j&&(dn(L,T,b,I+4,H,U),hn(O,k,R,M,P,I+4,H,U)),S.La&&(mn(L,T,b,I,H,U),yn(O,k,R,M,P,I,H,U)),0<_&&(ln(L,T,b,I+4,H,U),fn(O,k,R,M,P,I+4,H,U)),S.La&&(pn(L,T,b,I,H,U),gn(O,k,R,M,P,I,H,U))}}if(a.ia&&alert("todo:DitherRow"),null!=A.put){if(B=16*E,E=16*(E+1),Q?(A.y=a.sa,A.O=a.ta+w,A.f=a.qa,A.N=a.ra+x,A.ea=a.Ha,A.W=a.Ia+x):(B-=v,A.y=f,A.O=h,A.f=p,A.N=l,A.ea=m,A.W=g),y||(E-=v),E>A.o&&(E=A.o),A.F=null,A.J=null,null!=a.Fa&&0<a.Fa.length&&B<E&&(A.J=lr(a,A,B,E-B),A.F=a.mb,null==A.F&&0==A.F.length)){u=Xe(a,3,"Could not decode alpha data.");break e}B<A.j&&(v=A.j-B,B=A.j,t(!(1&v)),A.O+=a.R*v,A.N+=a.B*(v>>1),A.W+=a.B*(v>>1),null!=A.F&&(A.J+=A.width*v)),B<E&&(A.O+=A.v,A.N+=A.v>>1,A.W+=A.v>>1,null!=A.F&&(A.J+=A.v),A.ka=B-A.j,A.U=A.va-A.v,A.T=E-B,u=A.put(A))}i+1!=a.Ic||y||(n(a.sa,a.ta-c,f,h+16*a.R,c),n(a.qa,a.ra-d,p,l+8*a.B,d),n(a.Ha,a.Ia-d,m,g+8*a.B,d))}if(!u)return Xe(e,6,"Output aborted.")}return 1}(e,r)),null!=r.bc&&r.bc(r),a&=1}return a?(e.cb=0,a):0}function et(e,t,r,n,o){o=e[t+r+32*n]+(o>>3),e[t+r+32*n]=-256&o?0>o?0:255:o}function tt(e,t,r,n,o,s){et(e,t,0,r,n+o),et(e,t,1,r,n+s),et(e,t,2,r,n-s),et(e,t,3,r,n-o)}function rt(e){return(20091*e>>16)+e}function nt(e,t,r,n){var o,i=0,a=s(16);for(o=0;4>o;++o){var A=e[t+0]+e[t+8],u=e[t+0]-e[t+8],c=(35468*e[t+4]>>16)-rt(e[t+12]),l=rt(e[t+4])+(35468*e[t+12]>>16);a[i+0]=A+l,a[i+1]=u+c,a[i+2]=u-c,a[i+3]=A-l,i+=4,t++}for(o=i=0;4>o;++o)A=(e=a[i+0]+4)+a[i+8],u=e-a[i+8],c=(35468*a[i+4]>>16)-rt(a[i+12]),et(r,n,0,0,A+(l=rt(a[i+4])+(35468*a[i+12]>>16))),et(r,n,1,0,u+c),et(r,n,2,0,u-c),et(r,n,3,0,A-l),i++,n+=32}function ot(e,t,r,n){var o=e[t+0]+4,s=35468*e[t+4]>>16,i=rt(e[t+4]),a=35468*e[t+1]>>16;tt(r,n,0,o+i,e=rt(e[t+1]),a),tt(r,n,1,o+s,e,a),tt(r,n,2,o-s,e,a),tt(r,n,3,o-i,e,a)}function st(e,t,r,n,o){nt(e,t,r,n),o&&nt(e,t+16,r,n+4)}function it(e,t,r,n){sn(e,t+0,r,n,1),sn(e,t+32,r,n+128,1)}function at(e,t,r,n){var o;for(e=e[t+0]+4,o=0;4>o;++o)for(t=0;4>t;++t)et(r,n,t,o,e)}function At(e,t,r,n){e[t+0]&&un(e,t+0,r,n),e[t+16]&&un(e,t+16,r,n+4),e[t+32]&&un(e,t+32,r,n+128),e[t+48]&&un(e,t+48,r,n+128+4)}function ut(e,t,r,n){var o,i=s(16);for(o=0;4>o;++o){var a=e[t+0+o]+e[t+12+o],A=e[t+4+o]+e[t+8+o],u=e[t+4+o]-e[t+8+o],c=e[t+0+o]-e[t+12+o];i[0+o]=a+A,i[8+o]=a-A,i[4+o]=c+u,i[12+o]=c-u}for(o=0;4>o;++o)a=(e=i[0+4*o]+3)+i[3+4*o],A=i[1+4*o]+i[2+4*o],u=i[1+4*o]-i[2+4*o],c=e-i[3+4*o],r[n+0]=a+A>>3,r[n+16]=c+u>>3,r[n+32]=a-A>>3,r[n+48]=c-u>>3,n+=64}function ct(e,t,r){var n,o=t-32,s=Tn,i=255-e[o-1];for(n=0;n<r;++n){var a,A=s,u=i+e[t-1];for(a=0;a<r;++a)e[t+a]=A[u+e[o+a]];t+=32}}function lt(e,t){ct(e,t,4)}function dt(e,t){ct(e,t,8)}function ft(e,t){ct(e,t,16)}function ht(e,t){var r;for(r=0;16>r;++r)n(e,t+32*r,e,t-32,16)}function pt(e,t){var r;for(r=16;0<r;--r)o(e,t,e[t-1],16),t+=32}function mt(e,t,r){var n;for(n=0;16>n;++n)o(t,r+32*n,e,16)}function gt(e,t){var r,n=16;for(r=0;16>r;++r)n+=e[t-1+32*r]+e[t+r-32];mt(n>>5,e,t)}function yt(e,t){var r,n=8;for(r=0;16>r;++r)n+=e[t-1+32*r];mt(n>>4,e,t)}function vt(e,t){var r,n=8;for(r=0;16>r;++r)n+=e[t+r-32];mt(n>>4,e,t)}function wt(e,t){mt(128,e,t)}function bt(e,t,r){return e+2*t+r+2>>2}function Bt(e,t){var r,o=t-32;for(o=new Uint8Array([bt(e[o-1],e[o+0],e[o+1]),bt(e[o+0],e[o+1],e[o+2]),bt(e[o+1],e[o+2],e[o+3]),bt(e[o+2],e[o+3],e[o+4])]),r=0;4>r;++r)n(e,t+32*r,o,0,o.length)}function jt(e,t){var r=e[t-1],n=e[t-1+32],o=e[t-1+64],s=e[t-1+96];Q(e,t+0,16843009*bt(e[t-1-32],r,n)),Q(e,t+32,16843009*bt(r,n,o)),Q(e,t+64,16843009*bt(n,o,s)),Q(e,t+96,16843009*bt(o,s,s))}function _t(e,t){var r,n=4;for(r=0;4>r;++r)n+=e[t+r-32]+e[t-1+32*r];for(n>>=3,r=0;4>r;++r)o(e,t+32*r,n,4)}function Ct(e,t){var r=e[t-1+0],n=e[t-1+32],o=e[t-1+64],s=e[t-1-32],i=e[t+0-32],a=e[t+1-32],A=e[t+2-32],u=e[t+3-32];e[t+0+96]=bt(n,o,e[t-1+96]),e[t+1+96]=e[t+0+64]=bt(r,n,o),e[t+2+96]=e[t+1+64]=e[t+0+32]=bt(s,r,n),e[t+3+96]=e[t+2+64]=e[t+1+32]=e[t+0+0]=bt(i,s,r),e[t+3+64]=e[t+2+32]=e[t+1+0]=bt(a,i,s),e[t+3+32]=e[t+2+0]=bt(A,a,i),e[t+3+0]=bt(u,A,a)}function xt(e,t){var r=e[t+1-32],n=e[t+2-32],o=e[t+3-32],s=e[t+4-32],i=e[t+5-32],a=e[t+6-32],A=e[t+7-32];e[t+0+0]=bt(e[t+0-32],r,n),e[t+1+0]=e[t+0+32]=bt(r,n,o),e[t+2+0]=e[t+1+32]=e[t+0+64]=bt(n,o,s),e[t+3+0]=e[t+2+32]=e[t+1+64]=e[t+0+96]=bt(o,s,i),e[t+3+32]=e[t+2+64]=e[t+1+96]=bt(s,i,a),e[t+3+64]=e[t+2+96]=bt(i,a,A),e[t+3+96]=bt(a,A,A)}function Et(e,t){var r=e[t-1+0],n=e[t-1+32],o=e[t-1+64],s=e[t-1-32],i=e[t+0-32],a=e[t+1-32],A=e[t+2-32],u=e[t+3-32];e[t+0+0]=e[t+1+64]=s+i+1>>1,e[t+1+0]=e[t+2+64]=i+a+1>>1,e[t+2+0]=e[t+3+64]=a+A+1>>1,e[t+3+0]=A+u+1>>1,e[t+0+96]=bt(o,n,r),e[t+0+64]=bt(n,r,s),e[t+0+32]=e[t+1+96]=bt(r,s,i),e[t+1+32]=e[t+2+96]=bt(s,i,a),e[t+2+32]=e[t+3+96]=bt(i,a,A),e[t+3+32]=bt(a,A,u)}function Nt(e,t){var r=e[t+0-32],n=e[t+1-32],o=e[t+2-32],s=e[t+3-32],i=e[t+4-32],a=e[t+5-32],A=e[t+6-32],u=e[t+7-32];e[t+0+0]=r+n+1>>1,e[t+1+0]=e[t+0+64]=n+o+1>>1,e[t+2+0]=e[t+1+64]=o+s+1>>1,e[t+3+0]=e[t+2+64]=s+i+1>>1,e[t+0+32]=bt(r,n,o),e[t+1+32]=e[t+0+96]=bt(n,o,s),e[t+2+32]=e[t+1+96]=bt(o,s,i),e[t+3+32]=e[t+2+96]=bt(s,i,a),e[t+3+64]=bt(i,a,A),e[t+3+96]=bt(a,A,u)}function Qt(e,t){var r=e[t-1+0],n=e[t-1+32],o=e[t-1+64],s=e[t-1+96];e[t+0+0]=r+n+1>>1,e[t+2+0]=e[t+0+32]=n+o+1>>1,e[t+2+32]=e[t+0+64]=o+s+1>>1,e[t+1+0]=bt(r,n,o),e[t+3+0]=e[t+1+32]=bt(n,o,s),e[t+3+32]=e[t+1+64]=bt(o,s,s),e[t+3+64]=e[t+2+64]=e[t+0+96]=e[t+1+96]=e[t+2+96]=e[t+3+96]=s}function Ft(e,t){var r=e[t-1+0],n=e[t-1+32],o=e[t-1+64],s=e[t-1+96],i=e[t-1-32],a=e[t+0-32],A=e[t+1-32],u=e[t+2-32];e[t+0+0]=e[t+2+32]=r+i+1>>1,e[t+0+32]=e[t+2+64]=n+r+1>>1,e[t+0+64]=e[t+2+96]=o+n+1>>1,e[t+0+96]=s+o+1>>1,e[t+3+0]=bt(a,A,u),e[t+2+0]=bt(i,a,A),e[t+1+0]=e[t+3+32]=bt(r,i,a),e[t+1+32]=e[t+3+64]=bt(n,r,i),e[t+1+64]=e[t+3+96]=bt(o,n,r),e[t+1+96]=bt(s,o,n)}function Ut(e,t){var r;for(r=0;8>r;++r)n(e,t+32*r,e,t-32,8)}function St(e,t){var r;for(r=0;8>r;++r)o(e,t,e[t-1],8),t+=32}function Lt(e,t,r){var n;for(n=0;8>n;++n)o(t,r+32*n,e,8)}function Tt(e,t){var r,n=8;for(r=0;8>r;++r)n+=e[t+r-32]+e[t-1+32*r];Lt(n>>4,e,t)}function Ht(e,t){var r,n=4;for(r=0;8>r;++r)n+=e[t+r-32];Lt(n>>3,e,t)}function It(e,t){var r,n=4;for(r=0;8>r;++r)n+=e[t-1+32*r];Lt(n>>3,e,t)}function Pt(e,t){Lt(128,e,t)}function Ot(e,t,r){var n=e[t-r],o=e[t+0],s=3*(o-n)+Sn[1020+e[t-2*r]-e[t+r]],i=Ln[112+(s+4>>3)];e[t-r]=Tn[255+n+Ln[112+(s+3>>3)]],e[t+0]=Tn[255+o-i]}function kt(e,t,r,n){var o=e[t+0],s=e[t+r];return Hn[255+e[t-2*r]-e[t-r]]>n||Hn[255+s-o]>n}function Rt(e,t,r,n){return 4*Hn[255+e[t-r]-e[t+0]]+Hn[255+e[t-2*r]-e[t+r]]<=n}function Mt(e,t,r,n,o){var s=e[t-3*r],i=e[t-2*r],a=e[t-r],A=e[t+0],u=e[t+r],c=e[t+2*r],l=e[t+3*r];return 4*Hn[255+a-A]+Hn[255+i-u]>n?0:Hn[255+e[t-4*r]-s]<=o&&Hn[255+s-i]<=o&&Hn[255+i-a]<=o&&Hn[255+l-c]<=o&&Hn[255+c-u]<=o&&Hn[255+u-A]<=o}function Dt(e,t,r,n){var o=2*n+1;for(n=0;16>n;++n)Rt(e,t+n,r,o)&&Ot(e,t+n,r)}function Kt(e,t,r,n){var o=2*n+1;for(n=0;16>n;++n)Rt(e,t+n*r,1,o)&&Ot(e,t+n*r,1)}function zt(e,t,r,n){var o;for(o=3;0<o;--o)Dt(e,t+=4*r,r,n)}function Vt(e,t,r,n){var o;for(o=3;0<o;--o)Kt(e,t+=4,r,n)}function qt(e,t,r,n,o,s,i,a){for(s=2*s+1;0<o--;){if(Mt(e,t,r,s,i))if(kt(e,t,r,a))Ot(e,t,r);else{var A=e,u=t,c=r,l=A[u-2*c],d=A[u-c],f=A[u+0],h=A[u+c],p=A[u+2*c],m=27*(y=Sn[1020+3*(f-d)+Sn[1020+l-h]])+63>>7,g=18*y+63>>7,y=9*y+63>>7;A[u-3*c]=Tn[255+A[u-3*c]+y],A[u-2*c]=Tn[255+l+g],A[u-c]=Tn[255+d+m],A[u+0]=Tn[255+f-m],A[u+c]=Tn[255+h-g],A[u+2*c]=Tn[255+p-y]}t+=n}}function Gt(e,t,r,n,o,s,i,a){for(s=2*s+1;0<o--;){if(Mt(e,t,r,s,i))if(kt(e,t,r,a))Ot(e,t,r);else{var A=e,u=t,c=r,l=A[u-c],d=A[u+0],f=A[u+c],h=Ln[112+(4+(p=3*(d-l))>>3)],p=Ln[112+(p+3>>3)],m=h+1>>1;A[u-2*c]=Tn[255+A[u-2*c]+m],A[u-c]=Tn[255+l+p],A[u+0]=Tn[255+d-h],A[u+c]=Tn[255+f-m]}t+=n}}function Xt(e,t,r,n,o,s){qt(e,t,r,1,16,n,o,s)}function Wt(e,t,r,n,o,s){qt(e,t,1,r,16,n,o,s)}function Jt(e,t,r,n,o,s){var i;for(i=3;0<i;--i)Gt(e,t+=4*r,r,1,16,n,o,s)}function Yt(e,t,r,n,o,s){var i;for(i=3;0<i;--i)Gt(e,t+=4,1,r,16,n,o,s)}function Zt(e,t,r,n,o,s,i,a){qt(e,t,o,1,8,s,i,a),qt(r,n,o,1,8,s,i,a)}function $t(e,t,r,n,o,s,i,a){qt(e,t,1,o,8,s,i,a),qt(r,n,1,o,8,s,i,a)}function er(e,t,r,n,o,s,i,a){Gt(e,t+4*o,o,1,8,s,i,a),Gt(r,n+4*o,o,1,8,s,i,a)}function tr(e,t,r,n,o,s,i,a){Gt(e,t+4,1,o,8,s,i,a),Gt(r,n+4,1,o,8,s,i,a)}function rr(){this.ba=new ie,this.ec=[],this.cc=[],this.Mc=[],this.Dc=this.Nc=this.dc=this.fc=0,this.Oa=new Ae,this.memory=0,this.Ib="OutputFunc",this.Jb="OutputAlphaFunc",this.Nd="OutputRowFunc"}function nr(){this.data=[],this.offset=this.kd=this.ha=this.w=0,this.na=[],this.xa=this.gb=this.Ja=this.Sa=this.P=0}function or(){this.nc=this.Ea=this.b=this.hc=0,this.K=[],this.w=0}function sr(){this.ua=0,this.Wa=new H,this.vb=new H,this.md=this.xc=this.wc=0,this.vc=[],this.Wb=0,this.Ya=new f,this.yc=new l}function ir(){this.xb=this.a=0,this.l=new qe,this.ca=new ie,this.V=[],this.Ba=0,this.Ta=[],this.Ua=0,this.m=new b,this.Pb=0,this.wd=new b,this.Ma=this.$=this.C=this.i=this.c=this.xd=0,this.s=new sr,this.ab=0,this.gc=i(4,or),this.Oc=0}function ar(){this.Lc=this.Z=this.$a=this.i=this.c=0,this.l=new qe,this.ic=0,this.ca=[],this.tb=0,this.qd=null,this.rd=0}function Ar(e,t,r,n,o,s,i){for(e=null==e?0:e[t+0],t=0;t<i;++t)o[s+t]=e+r[n+t]&255,e=o[s+t]}function ur(e,t,r,n,o,s,i){var a;if(null==e)Ar(null,null,r,n,o,s,i);else for(a=0;a<i;++a)o[s+a]=e[t+a]+r[n+a]&255}function cr(e,t,r,n,o,s,i){if(null==e)Ar(null,null,r,n,o,s,i);else{var a,A=e[t+0],u=A,c=A;for(a=0;a<i;++a)u=c+(A=e[t+a])-u,c=r[n+a]+(-256&u?0>u?0:255:u)&255,u=A,o[s+a]=c}}function lr(e,r,o,i){var a=r.width,A=r.o;if(t(null!=e&&null!=r),0>o||0>=i||o+i>A)return null;if(!e.Cc){if(null==e.ga){var u;if(e.ga=new ar,(u=null==e.ga)||(u=r.width*r.o,t(0==e.Gb.length),e.Gb=s(u),e.Uc=0,null==e.Gb?u=0:(e.mb=e.Gb,e.nb=e.Uc,e.rc=null,u=1),u=!u),!u){u=e.ga;var c=e.Fa,l=e.P,d=e.qc,f=e.mb,h=e.nb,p=l+1,m=d-1,y=u.l;if(t(null!=c&&null!=f&&null!=r),go[0]=null,go[1]=Ar,go[2]=ur,go[3]=cr,u.ca=f,u.tb=h,u.c=r.width,u.i=r.height,t(0<u.c&&0<u.i),1>=d)r=0;else if(u.$a=c[l+0]>>0&3,u.Z=c[l+0]>>2&3,u.Lc=c[l+0]>>4&3,l=c[l+0]>>6&3,0>u.$a||1<u.$a||4<=u.Z||1<u.Lc||l)r=0;else if(y.put=fe,y.ac=de,y.bc=he,y.ma=u,y.width=r.width,y.height=r.height,y.Da=r.Da,y.v=r.v,y.va=r.va,y.j=r.j,y.o=r.o,u.$a)e:{t(1==u.$a),r=Ne();t:for(;;){if(null==r){r=0;break e}if(t(null!=u),u.mc=r,r.c=u.c,r.i=u.i,r.l=u.l,r.l.ma=u,r.l.width=u.c,r.l.height=u.i,r.a=0,g(r.m,c,p,m),!Qe(u.c,u.i,1,r,null))break t;if(1==r.ab&&3==r.gc[0].hc&&je(r.s)?(u.ic=1,c=r.c*r.i,r.Ta=null,r.Ua=0,r.V=s(c),r.Ba=0,null==r.V?(r.a=1,r=0):r=1):(u.ic=0,r=Fe(r,u.c)),!r)break t;r=1;break e}u.mc=null,r=0}else r=m>=u.c*u.i;u=!r}if(u)return null;1!=e.ga.Lc?e.Ga=0:i=A-o}t(null!=e.ga),t(o+i<=A);e:{if(r=(c=e.ga).c,A=c.l.o,0==c.$a){if(p=e.rc,m=e.Vc,y=e.Fa,l=e.P+1+o*r,d=e.mb,f=e.nb+o*r,t(l<=e.P+e.qc),0!=c.Z)for(t(null!=go[c.Z]),u=0;u<i;++u)go[c.Z](p,m,y,l,d,f,r),p=d,m=f,f+=r,l+=r;else for(u=0;u<i;++u)n(d,f,y,l,r),p=d,m=f,f+=r,l+=r;e.rc=p,e.Vc=m}else{if(t(null!=c.mc),r=o+i,t(null!=(u=c.mc)),t(r<=u.i),u.C>=r)r=1;else if(c.ic||mr(),c.ic){c=u.V,p=u.Ba,m=u.c;var v=u.i,w=(y=1,l=u.$/m,d=u.$%m,f=u.m,h=u.s,u.$),b=m*v,B=m*r,_=h.wc,x=w<B?we(h,d,l):null;t(w<=b),t(r<=v),t(je(h));t:for(;;){for(;!f.h&&w<B;){if(d&_||(x=we(h,d,l)),t(null!=x),C(f),256>(v=ye(x.G[0],x.H[0],f)))c[p+w]=v,++w,++d>=m&&(d=0,++l<=r&&!(l%16)&&Ce(u,l));else{if(!(280>v)){y=0;break t}v=me(v-256,f);var E,N=ye(x.G[4],x.H[4],f);if(C(f),!(w>=(N=ge(m,N=me(N,f)))&&b-w>=v)){y=0;break t}for(E=0;E<v;++E)c[p+w+E]=c[p+w+E-N];for(w+=v,d+=v;d>=m;)d-=m,++l<=r&&!(l%16)&&Ce(u,l);w<B&&d&_&&(x=we(h,d,l))}t(f.h==j(f))}Ce(u,l>r?r:l);break t}!y||f.h&&w<b?(y=0,u.a=f.h?5:3):u.$=w,r=y}else r=xe(u,u.V,u.Ba,u.c,u.i,r,Ue);if(!r){i=0;break e}}o+i>=A&&(e.Cc=1),i=1}if(!i)return null;if(e.Cc&&(null!=(i=e.ga)&&(i.mc=null),e.ga=null,0<e.Ga))return alert("todo:WebPDequantizeLevels"),null}return e.nb+o*a}function dr(e,t,r,n,o,s){for(;0<o--;){var i,a=e,A=t+(r?1:0),u=e,c=t+(r?0:3);for(i=0;i<n;++i){var l=u[c+4*i];255!=l&&(l*=32897,a[A+4*i+0]=a[A+4*i+0]*l>>23,a[A+4*i+1]=a[A+4*i+1]*l>>23,a[A+4*i+2]=a[A+4*i+2]*l>>23)}t+=s}}function fr(e,t,r,n,o){for(;0<n--;){var s;for(s=0;s<r;++s){var i=e[t+2*s+0],a=15&(u=e[t+2*s+1]),A=4369*a,u=(240&u|u>>4)*A>>16;e[t+2*s+0]=(240&i|i>>4)*A>>16&240|(15&i|i<<4)*A>>16>>4&15,e[t+2*s+1]=240&u|a}t+=o}}function hr(e,t,r,n,o,s,i,a){var A,u,c=255;for(u=0;u<o;++u){for(A=0;A<n;++A){var l=e[t+A];s[i+4*A]=l,c&=l}t+=r,i+=a}return 255!=c}function pr(e,t,r,n,o){var s;for(s=0;s<o;++s)r[n+s]=e[t+s]>>8}function mr(){jn=dr,_n=fr,Cn=hr,xn=pr}function gr(r,n,o){e[r]=function(e,r,s,i,a,A,u,c,l,d,f,h,p,m,g,y,v){var w,b=v-1>>1,B=a[A+0]|u[c+0]<<16,j=l[d+0]|f[h+0]<<16;t(null!=e);var _=3*B+j+131074>>2;for(n(e[r+0],255&_,_>>16,p,m),null!=s&&(_=3*j+B+131074>>2,n(s[i+0],255&_,_>>16,g,y)),w=1;w<=b;++w){var C=a[A+w]|u[c+w]<<16,x=l[d+w]|f[h+w]<<16,E=B+C+j+x+524296,N=E+2*(C+j)>>3;_=N+B>>1,B=(E=E+2*(B+x)>>3)+C>>1,n(e[r+2*w-1],255&_,_>>16,p,m+(2*w-1)*o),n(e[r+2*w-0],255&B,B>>16,p,m+(2*w-0)*o),null!=s&&(_=E+j>>1,B=N+x>>1,n(s[i+2*w-1],255&_,_>>16,g,y+(2*w-1)*o),n(s[i+2*w+0],255&B,B>>16,g,y+(2*w+0)*o)),B=C,j=x}1&v||(_=3*B+j+131074>>2,n(e[r+v-1],255&_,_>>16,p,m+(v-1)*o),null!=s&&(_=3*j+B+131074>>2,n(s[i+v-1],255&_,_>>16,g,y+(v-1)*o)))}}function yr(){yo[In]=vo,yo[Pn]=bo,yo[On]=wo,yo[kn]=Bo,yo[Rn]=jo,yo[Mn]=_o,yo[Dn]=Co,yo[Kn]=bo,yo[zn]=Bo,yo[Vn]=jo,yo[qn]=_o}function vr(e){return e&~Uo?0>e?0:255:e>>Fo}function wr(e,t){return vr((19077*e>>8)+(26149*t>>8)-14234)}function br(e,t,r){return vr((19077*e>>8)-(6419*t>>8)-(13320*r>>8)+8708)}function Br(e,t){return vr((19077*e>>8)+(33050*t>>8)-17685)}function jr(e,t,r,n,o){n[o+0]=wr(e,r),n[o+1]=br(e,t,r),n[o+2]=Br(e,t)}function _r(e,t,r,n,o){n[o+0]=Br(e,t),n[o+1]=br(e,t,r),n[o+2]=wr(e,r)}function Cr(e,t,r,n,o){var s=br(e,t,r);t=s<<3&224|Br(e,t)>>3,n[o+0]=248&wr(e,r)|s>>5,n[o+1]=t}function xr(e,t,r,n,o){var s=240&Br(e,t)|15;n[o+0]=240&wr(e,r)|br(e,t,r)>>4,n[o+1]=s}function Er(e,t,r,n,o){n[o+0]=255,jr(e,t,r,n,o+1)}function Nr(e,t,r,n,o){_r(e,t,r,n,o),n[o+3]=255}function Qr(e,t,r,n,o){jr(e,t,r,n,o),n[o+3]=255}function Ve(e,t){return 0>e?0:e>t?t:e}function Fr(t,r,n){e[t]=function(e,t,o,s,i,a,A,u,c){for(var l=u+(-2&c)*n;u!=l;)r(e[t+0],o[s+0],i[a+0],A,u),r(e[t+1],o[s+0],i[a+0],A,u+n),t+=2,++s,++a,u+=2*n;1&c&&r(e[t+0],o[s+0],i[a+0],A,u)}}function Ur(e,t,r){return 0==r?0==e?0==t?6:5:0==t?4:0:r}function Sr(e,t,r,n,o){switch(e>>>30){case 3:sn(t,r,n,o,0);break;case 2:an(t,r,n,o);break;case 1:un(t,r,n,o)}}function Lr(e,t){var r,s,i=t.M,a=t.Nb,A=e.oc,u=e.pc+40,c=e.oc,l=e.pc+584,d=e.oc,f=e.pc+600;for(r=0;16>r;++r)A[u+32*r-1]=129;for(r=0;8>r;++r)c[l+32*r-1]=129,d[f+32*r-1]=129;for(0<i?A[u-1-32]=c[l-1-32]=d[f-1-32]=129:(o(A,u-32-1,127,21),o(c,l-32-1,127,9),o(d,f-32-1,127,9)),s=0;s<e.za;++s){var h=t.ya[t.aa+s];if(0<s){for(r=-1;16>r;++r)n(A,u+32*r-4,A,u+32*r+12,4);for(r=-1;8>r;++r)n(c,l+32*r-4,c,l+32*r+4,4),n(d,f+32*r-4,d,f+32*r+4,4)}var p=e.Gd,m=e.Hd+s,g=h.ad,y=h.Hc;if(0<i&&(n(A,u-32,p[m].y,0,16),n(c,l-32,p[m].f,0,8),n(d,f-32,p[m].ea,0,8)),h.Za){var v=A,w=u-32+16;for(0<i&&(s>=e.za-1?o(v,w,p[m].y[15],4):n(v,w,p[m+1].y,0,4)),r=0;4>r;r++)v[w+128+r]=v[w+256+r]=v[w+384+r]=v[w+0+r];for(r=0;16>r;++r,y<<=2)v=A,w=u+ko[r],fo[h.Ob[r]](v,w),Sr(y,g,16*+r,v,w)}else if(v=Ur(s,i,h.Ob[0]),lo[v](A,u),0!=y)for(r=0;16>r;++r,y<<=2)Sr(y,g,16*+r,A,u+ko[r]);for(r=h.Gc,v=Ur(s,i,h.Dd),ho[v](c,l),ho[v](d,f),y=g,v=c,w=l,255&(h=r>>0)&&(170&h?An(y,256,v,w):cn(y,256,v,w)),h=d,y=f,255&(r>>=8)&&(170&r?An(g,320,h,y):cn(g,320,h,y)),i<e.Ub-1&&(n(p[m].y,0,A,u+480,16),n(p[m].f,0,c,l+224,8),n(p[m].ea,0,d,f+224,8)),r=8*a*e.B,p=e.sa,m=e.ta+16*s+16*a*e.R,g=e.qa,h=e.ra+8*s+r,y=e.Ha,v=e.Ia+8*s+r,r=0;16>r;++r)n(p,m+r*e.R,A,u+32*r,16);for(r=0;8>r;++r)n(g,h+r*e.B,c,l+32*r,8),n(y,v+r*e.B,d,f+32*r,8)}}function Tr(e,n,o,s,i,a,A,u,c){var l=[0],d=[0],f=0,h=null!=c?c.kd:0,p=null!=c?c:new nr;if(null==e||12>o)return 7;p.data=e,p.w=n,p.ha=o,n=[n],o=[o],p.gb=[p.gb];e:{var m=n,y=o,v=p.gb;if(t(null!=e),t(null!=y),t(null!=v),v[0]=0,12<=y[0]&&!r(e,m[0],"RIFF")){if(r(e,m[0]+8,"WEBP")){v=3;break e}var w=S(e,m[0]+4);if(12>w||4294967286<w){v=3;break e}if(h&&w>y[0]-8){v=7;break e}v[0]=w,m[0]+=12,y[0]-=12}v=0}if(0!=v)return v;for(w=0<p.gb[0],o=o[0];;){e:{var B=e;y=n,v=o;var j=l,_=d,C=m=[0];if((N=f=[f])[0]=0,8>v[0])v=7;else{if(!r(B,y[0],"VP8X")){if(10!=S(B,y[0]+4)){v=3;break e}if(18>v[0]){v=7;break e}var x=S(B,y[0]+8),E=1+U(B,y[0]+12);if(2147483648<=E*(B=1+U(B,y[0]+15))){v=3;break e}null!=C&&(C[0]=x),null!=j&&(j[0]=E),null!=_&&(_[0]=B),y[0]+=18,v[0]-=18,N[0]=1}v=0}}if(f=f[0],m=m[0],0!=v)return v;if(y=!!(2&m),!w&&f)return 3;if(null!=a&&(a[0]=!!(16&m)),null!=A&&(A[0]=y),null!=u&&(u[0]=0),A=l[0],m=d[0],f&&y&&null==c){v=0;break}if(4>o){v=7;break}if(w&&f||!w&&!f&&!r(e,n[0],"ALPH")){o=[o],p.na=[p.na],p.P=[p.P],p.Sa=[p.Sa];e:{x=e,v=n,w=o;var N=p.gb;j=p.na,_=p.P,C=p.Sa,E=22,t(null!=x),t(null!=w),B=v[0];var Q=w[0];for(t(null!=j),t(null!=C),j[0]=null,_[0]=null,C[0]=0;;){if(v[0]=B,w[0]=Q,8>Q){v=7;break e}var F=S(x,B+4);if(4294967286<F){v=3;break e}var L=8+F+1&-2;if(E+=L,0<N&&E>N){v=3;break e}if(!r(x,B,"VP8 ")||!r(x,B,"VP8L")){v=0;break e}if(Q[0]<L){v=7;break e}r(x,B,"ALPH")||(j[0]=x,_[0]=B+8,C[0]=F),B+=L,Q-=L}}if(o=o[0],p.na=p.na[0],p.P=p.P[0],p.Sa=p.Sa[0],0!=v)break}o=[o],p.Ja=[p.Ja],p.xa=[p.xa];e:if(N=e,v=n,w=o,j=p.gb[0],_=p.Ja,C=p.xa,x=v[0],B=!r(N,x,"VP8 "),E=!r(N,x,"VP8L"),t(null!=N),t(null!=w),t(null!=_),t(null!=C),8>w[0])v=7;else{if(B||E){if(N=S(N,x+4),12<=j&&N>j-12){v=3;break e}if(h&&N>w[0]-8){v=7;break e}_[0]=N,v[0]+=8,w[0]-=8,C[0]=E}else C[0]=5<=w[0]&&47==N[x+0]&&!(N[x+4]>>5),_[0]=w[0];v=0}if(o=o[0],p.Ja=p.Ja[0],p.xa=p.xa[0],n=n[0],0!=v)break;if(4294967286<p.Ja)return 3;if(null==u||y||(u[0]=p.xa?2:1),A=[A],m=[m],p.xa){if(5>o){v=7;break}u=A,h=m,y=a,null==e||5>o?e=0:5<=o&&47==e[n+0]&&!(e[n+4]>>5)?(w=[0],N=[0],j=[0],g(_=new b,e,n,o),pe(_,w,N,j)?(null!=u&&(u[0]=w[0]),null!=h&&(h[0]=N[0]),null!=y&&(y[0]=j[0]),e=1):e=0):e=0}else{if(10>o){v=7;break}u=m,null==e||10>o||!We(e,n+3,o-3)?e=0:(h=e[n+0]|e[n+1]<<8|e[n+2]<<16,y=16383&(e[n+7]<<8|e[n+6]),e=16383&(e[n+9]<<8|e[n+8]),1&h||3<(h>>1&7)||!(h>>4&1)||h>>5>=p.Ja||!y||!e?e=0:(A&&(A[0]=y),u&&(u[0]=e),e=1))}if(!e)return 3;if(A=A[0],m=m[0],f&&(l[0]!=A||d[0]!=m))return 3;null!=c&&(c[0]=p,c.offset=n-c.w,t(4294967286>n-c.w),t(c.offset==c.ha-o));break}return 0==v||7==v&&f&&null==c?(null!=a&&(a[0]|=null!=p.na&&0<p.na.length),null!=s&&(s[0]=A),null!=i&&(i[0]=m),0):v}function Hr(e,t,r){var n=t.width,o=t.height,s=0,i=0,a=n,A=o;if(t.Da=null!=e&&0<e.Da,t.Da&&(a=e.cd,A=e.bd,s=e.v,i=e.j,11>r||(s&=-2,i&=-2),0>s||0>i||0>=a||0>=A||s+a>n||i+A>o))return 0;if(t.v=s,t.j=i,t.va=s+a,t.o=i+A,t.U=a,t.T=A,t.da=null!=e&&0<e.da,t.da){if(!I(a,A,r=[e.ib],s=[e.hb]))return 0;t.ib=r[0],t.hb=s[0]}return t.ob=null!=e&&e.ob,t.Kb=null==e||!e.Sd,t.da&&(t.ob=t.ib<3*n/4&&t.hb<3*o/4,t.Kb=0),1}function Ir(e){if(null==e)return 2;if(11>e.S){var t=e.f.RGBA;t.fb+=(e.height-1)*t.A,t.A=-t.A}else t=e.f.kb,e=e.height,t.O+=(e-1)*t.fa,t.fa=-t.fa,t.N+=(e-1>>1)*t.Ab,t.Ab=-t.Ab,t.W+=(e-1>>1)*t.Db,t.Db=-t.Db,null!=t.F&&(t.J+=(e-1)*t.lb,t.lb=-t.lb);return 0}function Pr(e,t,r,n){if(null==n||0>=e||0>=t)return 2;if(null!=r){if(r.Da){var o=r.cd,i=r.bd,a=-2&r.v,A=-2&r.j;if(0>a||0>A||0>=o||0>=i||a+o>e||A+i>t)return 2;e=o,t=i}if(r.da){if(!I(e,t,o=[r.ib],i=[r.hb]))return 2;e=o[0],t=i[0]}}n.width=e,n.height=t;e:{var u=n.width,c=n.height;if(e=n.S,0>=u||0>=c||!(e>=In&&13>e))e=2;else{if(0>=n.Rd&&null==n.sd){a=i=o=t=0;var l=(A=u*Ko[e])*c;if(11>e||(i=(c+1)/2*(t=(u+1)/2),12==e&&(a=(o=u)*c)),null==(c=s(l+2*i+a))){e=1;break e}n.sd=c,11>e?((u=n.f.RGBA).eb=c,u.fb=0,u.A=A,u.size=l):((u=n.f.kb).y=c,u.O=0,u.fa=A,u.Fd=l,u.f=c,u.N=0+l,u.Ab=t,u.Cd=i,u.ea=c,u.W=0+l+i,u.Db=t,u.Ed=i,12==e&&(u.F=c,u.J=0+l+2*i),u.Tc=a,u.lb=o)}if(t=1,o=n.S,i=n.width,a=n.height,o>=In&&13>o)if(11>o)e=n.f.RGBA,t&=(A=Math.abs(e.A))*(a-1)+i<=e.size,t&=A>=i*Ko[o],t&=null!=e.eb;else{e=n.f.kb,A=(i+1)/2,l=(a+1)/2,u=Math.abs(e.fa),c=Math.abs(e.Ab);var d=Math.abs(e.Db),f=Math.abs(e.lb),h=f*(a-1)+i;t&=u*(a-1)+i<=e.Fd,t&=c*(l-1)+A<=e.Cd,t=(t&=d*(l-1)+A<=e.Ed)&u>=i&c>=A&d>=A,t&=null!=e.y,t&=null!=e.f,t&=null!=e.ea,12==o&&(t&=f>=i,t&=h<=e.Tc,t&=null!=e.F)}else t=0;e=t?0:2}}return 0!=e||null!=r&&r.fd&&(e=Ir(n)),e}var Or=64,kr=[0,1,3,7,15,31,63,127,255,511,1023,2047,4095,8191,16383,32767,65535,131071,262143,524287,1048575,2097151,4194303,8388607,16777215],Rr=24,Mr=32,Dr=8,Kr=[0,0,1,1,2,2,2,2,3,3,3,3,3,3,3,3,4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7];k("Predictor0","PredictorAdd0"),e.Predictor0=function(){return 4278190080},e.Predictor1=function(e){return e},e.Predictor2=function(e,t,r){return t[r+0]},e.Predictor3=function(e,t,r){return t[r+1]},e.Predictor4=function(e,t,r){return t[r-1]},e.Predictor5=function(e,t,r){return M(M(e,t[r+1]),t[r+0])},e.Predictor6=function(e,t,r){return M(e,t[r-1])},e.Predictor7=function(e,t,r){return M(e,t[r+0])},e.Predictor8=function(e,t,r){return M(t[r-1],t[r+0])},e.Predictor9=function(e,t,r){return M(t[r+0],t[r+1])},e.Predictor10=function(e,t,r){return M(M(e,t[r-1]),M(t[r+0],t[r+1]))},e.Predictor11=function(e,t,r){var n=t[r+0];return 0>=z(n>>24&255,e>>24&255,(t=t[r-1])>>24&255)+z(n>>16&255,e>>16&255,t>>16&255)+z(n>>8&255,e>>8&255,t>>8&255)+z(255&n,255&e,255&t)?n:e},e.Predictor12=function(e,t,r){var n=t[r+0];return(D((e>>24&255)+(n>>24&255)-((t=t[r-1])>>24&255))<<24|D((e>>16&255)+(n>>16&255)-(t>>16&255))<<16|D((e>>8&255)+(n>>8&255)-(t>>8&255))<<8|D((255&e)+(255&n)-(255&t)))>>>0},e.Predictor13=function(e,t,r){var n=t[r-1];return(K((e=M(e,t[r+0]))>>24&255,n>>24&255)<<24|K(e>>16&255,n>>16&255)<<16|K(e>>8&255,n>>8&255)<<8|K(e>>0&255,n>>0&255))>>>0};var zr=e.PredictorAdd0;e.PredictorAdd1=V,k("Predictor2","PredictorAdd2"),k("Predictor3","PredictorAdd3"),k("Predictor4","PredictorAdd4"),k("Predictor5","PredictorAdd5"),k("Predictor6","PredictorAdd6"),k("Predictor7","PredictorAdd7"),k("Predictor8","PredictorAdd8"),k("Predictor9","PredictorAdd9"),k("Predictor10","PredictorAdd10"),k("Predictor11","PredictorAdd11"),k("Predictor12","PredictorAdd12"),k("Predictor13","PredictorAdd13");var Vr=e.PredictorAdd2;W("ColorIndexInverseTransform","MapARGB","32b",(function(e){return e>>8&255}),(function(e){return e})),W("VP8LColorIndexInverseTransformAlpha","MapAlpha","8b",(function(e){return e}),(function(e){return e>>8&255}));var qr,Gr=e.ColorIndexInverseTransform,Xr=e.MapARGB,Wr=e.VP8LColorIndexInverseTransformAlpha,Jr=e.MapAlpha,Yr=e.VP8LPredictorsAdd=[];Yr.length=16,(e.VP8LPredictors=[]).length=16,(e.VP8LPredictorsAdd_C=[]).length=16,(e.VP8LPredictors_C=[]).length=16;var Zr,$r,en,tn,rn,nn,on,sn,an,An,un,cn,ln,dn,fn,hn,pn,mn,gn,yn,vn,wn,bn,Bn,jn,_n,Cn,xn,En=s(511),Nn=s(2041),Qn=s(225),Fn=s(767),Un=0,Sn=Nn,Ln=Qn,Tn=Fn,Hn=En,In=0,Pn=1,On=2,kn=3,Rn=4,Mn=5,Dn=6,Kn=7,zn=8,Vn=9,qn=10,Gn=[2,3,7],Xn=[3,3,11],Wn=[280,256,256,256,40],Jn=[0,1,1,1,0],Yn=[17,18,0,1,2,3,4,5,16,6,7,8,9,10,11,12,13,14,15],Zn=[24,7,23,25,40,6,39,41,22,26,38,42,56,5,55,57,21,27,54,58,37,43,72,4,71,73,20,28,53,59,70,74,36,44,88,69,75,52,60,3,87,89,19,29,86,90,35,45,68,76,85,91,51,61,104,2,103,105,18,30,102,106,34,46,84,92,67,77,101,107,50,62,120,1,119,121,83,93,17,31,100,108,66,78,118,122,33,47,117,123,49,63,99,109,82,94,0,116,124,65,79,16,32,98,110,48,115,125,81,95,64,114,126,97,111,80,113,127,96,112],$n=[2954,2956,2958,2962,2970,2986,3018,3082,3212,3468,3980,5004],eo=8,to=[4,5,6,7,8,9,10,10,11,12,13,14,15,16,17,17,18,19,20,20,21,21,22,22,23,23,24,25,25,26,27,28,29,30,31,32,33,34,35,36,37,37,38,39,40,41,42,43,44,45,46,46,47,48,49,50,51,52,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,76,77,78,79,80,81,82,83,84,85,86,87,88,89,91,93,95,96,98,100,101,102,104,106,108,110,112,114,116,118,122,124,126,128,130,132,134,136,138,140,143,145,148,151,154,157],ro=[4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32,33,34,35,36,37,38,39,40,41,42,43,44,45,46,47,48,49,50,51,52,53,54,55,56,57,58,60,62,64,66,68,70,72,74,76,78,80,82,84,86,88,90,92,94,96,98,100,102,104,106,108,110,112,114,116,119,122,125,128,131,134,137,140,143,146,149,152,155,158,161,164,167,170,173,177,181,185,189,193,197,201,205,209,213,217,221,225,229,234,239,245,249,254,259,264,269,274,279,284],no=null,oo=[[173,148,140,0],[176,155,140,135,0],[180,157,141,134,130,0],[254,254,243,230,196,177,153,140,133,130,129,0]],so=[0,1,4,8,5,2,3,6,9,12,13,10,7,11,14,15],io=[-0,1,-1,2,-2,3,4,6,-3,5,-4,-5,-6,7,-7,8,-8,-9],ao=[[[[128,128,128,128,128,128,128,128,128,128,128],[128,128,128,128,128,128,128,128,128,128,128],[128,128,128,128,128,128,128,128,128,128,128]],[[253,136,254,255,228,219,128,128,128,128,128],[189,129,242,255,227,213,255,219,128,128,128],[106,126,227,252,214,209,255,255,128,128,128]],[[1,98,248,255,236,226,255,255,128,128,128],[181,133,238,254,221,234,255,154,128,128,128],[78,134,202,247,198,180,255,219,128,128,128]],[[1,185,249,255,243,255,128,128,128,128,128],[184,150,247,255,236,224,128,128,128,128,128],[77,110,216,255,236,230,128,128,128,128,128]],[[1,101,251,255,241,255,128,128,128,128,128],[170,139,241,252,236,209,255,255,128,128,128],[37,116,196,243,228,255,255,255,128,128,128]],[[1,204,254,255,245,255,128,128,128,128,128],[207,160,250,255,238,128,128,128,128,128,128],[102,103,231,255,211,171,128,128,128,128,128]],[[1,152,252,255,240,255,128,128,128,128,128],[177,135,243,255,234,225,128,128,128,128,128],[80,129,211,255,194,224,128,128,128,128,128]],[[1,1,255,128,128,128,128,128,128,128,128],[246,1,255,128,128,128,128,128,128,128,128],[255,128,128,128,128,128,128,128,128,128,128]]],[[[198,35,237,223,193,187,162,160,145,155,62],[131,45,198,221,172,176,220,157,252,221,1],[68,47,146,208,149,167,221,162,255,223,128]],[[1,149,241,255,221,224,255,255,128,128,128],[184,141,234,253,222,220,255,199,128,128,128],[81,99,181,242,176,190,249,202,255,255,128]],[[1,129,232,253,214,197,242,196,255,255,128],[99,121,210,250,201,198,255,202,128,128,128],[23,91,163,242,170,187,247,210,255,255,128]],[[1,200,246,255,234,255,128,128,128,128,128],[109,178,241,255,231,245,255,255,128,128,128],[44,130,201,253,205,192,255,255,128,128,128]],[[1,132,239,251,219,209,255,165,128,128,128],[94,136,225,251,218,190,255,255,128,128,128],[22,100,174,245,186,161,255,199,128,128,128]],[[1,182,249,255,232,235,128,128,128,128,128],[124,143,241,255,227,234,128,128,128,128,128],[35,77,181,251,193,211,255,205,128,128,128]],[[1,157,247,255,236,231,255,255,128,128,128],[121,141,235,255,225,227,255,255,128,128,128],[45,99,188,251,195,217,255,224,128,128,128]],[[1,1,251,255,213,255,128,128,128,128,128],[203,1,248,255,255,128,128,128,128,128,128],[137,1,177,255,224,255,128,128,128,128,128]]],[[[253,9,248,251,207,208,255,192,128,128,128],[175,13,224,243,193,185,249,198,255,255,128],[73,17,171,221,161,179,236,167,255,234,128]],[[1,95,247,253,212,183,255,255,128,128,128],[239,90,244,250,211,209,255,255,128,128,128],[155,77,195,248,188,195,255,255,128,128,128]],[[1,24,239,251,218,219,255,205,128,128,128],[201,51,219,255,196,186,128,128,128,128,128],[69,46,190,239,201,218,255,228,128,128,128]],[[1,191,251,255,255,128,128,128,128,128,128],[223,165,249,255,213,255,128,128,128,128,128],[141,124,248,255,255,128,128,128,128,128,128]],[[1,16,248,255,255,128,128,128,128,128,128],[190,36,230,255,236,255,128,128,128,128,128],[149,1,255,128,128,128,128,128,128,128,128]],[[1,226,255,128,128,128,128,128,128,128,128],[247,192,255,128,128,128,128,128,128,128,128],[240,128,255,128,128,128,128,128,128,128,128]],[[1,134,252,255,255,128,128,128,128,128,128],[213,62,250,255,255,128,128,128,128,128,128],[55,93,255,128,128,128,128,128,128,128,128]],[[128,128,128,128,128,128,128,128,128,128,128],[128,128,128,128,128,128,128,128,128,128,128],[128,128,128,128,128,128,128,128,128,128,128]]],[[[202,24,213,235,186,191,220,160,240,175,255],[126,38,182,232,169,184,228,174,255,187,128],[61,46,138,219,151,178,240,170,255,216,128]],[[1,112,230,250,199,191,247,159,255,255,128],[166,109,228,252,211,215,255,174,128,128,128],[39,77,162,232,172,180,245,178,255,255,128]],[[1,52,220,246,198,199,249,220,255,255,128],[124,74,191,243,183,193,250,221,255,255,128],[24,71,130,219,154,170,243,182,255,255,128]],[[1,182,225,249,219,240,255,224,128,128,128],[149,150,226,252,216,205,255,171,128,128,128],[28,108,170,242,183,194,254,223,255,255,128]],[[1,81,230,252,204,203,255,192,128,128,128],[123,102,209,247,188,196,255,233,128,128,128],[20,95,153,243,164,173,255,203,128,128,128]],[[1,222,248,255,216,213,128,128,128,128,128],[168,175,246,252,235,205,255,255,128,128,128],[47,116,215,255,211,212,255,255,128,128,128]],[[1,121,236,253,212,214,255,255,128,128,128],[141,84,213,252,201,202,255,219,128,128,128],[42,80,160,240,162,185,255,205,128,128,128]],[[1,1,255,128,128,128,128,128,128,128,128],[244,1,255,128,128,128,128,128,128,128,128],[238,1,255,128,128,128,128,128,128,128,128]]]],Ao=[[[231,120,48,89,115,113,120,152,112],[152,179,64,126,170,118,46,70,95],[175,69,143,80,85,82,72,155,103],[56,58,10,171,218,189,17,13,152],[114,26,17,163,44,195,21,10,173],[121,24,80,195,26,62,44,64,85],[144,71,10,38,171,213,144,34,26],[170,46,55,19,136,160,33,206,71],[63,20,8,114,114,208,12,9,226],[81,40,11,96,182,84,29,16,36]],[[134,183,89,137,98,101,106,165,148],[72,187,100,130,157,111,32,75,80],[66,102,167,99,74,62,40,234,128],[41,53,9,178,241,141,26,8,107],[74,43,26,146,73,166,49,23,157],[65,38,105,160,51,52,31,115,128],[104,79,12,27,217,255,87,17,7],[87,68,71,44,114,51,15,186,23],[47,41,14,110,182,183,21,17,194],[66,45,25,102,197,189,23,18,22]],[[88,88,147,150,42,46,45,196,205],[43,97,183,117,85,38,35,179,61],[39,53,200,87,26,21,43,232,171],[56,34,51,104,114,102,29,93,77],[39,28,85,171,58,165,90,98,64],[34,22,116,206,23,34,43,166,73],[107,54,32,26,51,1,81,43,31],[68,25,106,22,64,171,36,225,114],[34,19,21,102,132,188,16,76,124],[62,18,78,95,85,57,50,48,51]],[[193,101,35,159,215,111,89,46,111],[60,148,31,172,219,228,21,18,111],[112,113,77,85,179,255,38,120,114],[40,42,1,196,245,209,10,25,109],[88,43,29,140,166,213,37,43,154],[61,63,30,155,67,45,68,1,209],[100,80,8,43,154,1,51,26,71],[142,78,78,16,255,128,34,197,171],[41,40,5,102,211,183,4,1,221],[51,50,17,168,209,192,23,25,82]],[[138,31,36,171,27,166,38,44,229],[67,87,58,169,82,115,26,59,179],[63,59,90,180,59,166,93,73,154],[40,40,21,116,143,209,34,39,175],[47,15,16,183,34,223,49,45,183],[46,17,33,183,6,98,15,32,183],[57,46,22,24,128,1,54,17,37],[65,32,73,115,28,128,23,128,205],[40,3,9,115,51,192,18,6,223],[87,37,9,115,59,77,64,21,47]],[[104,55,44,218,9,54,53,130,226],[64,90,70,205,40,41,23,26,57],[54,57,112,184,5,41,38,166,213],[30,34,26,133,152,116,10,32,134],[39,19,53,221,26,114,32,73,255],[31,9,65,234,2,15,1,118,73],[75,32,12,51,192,255,160,43,51],[88,31,35,67,102,85,55,186,85],[56,21,23,111,59,205,45,37,192],[55,38,70,124,73,102,1,34,98]],[[125,98,42,88,104,85,117,175,82],[95,84,53,89,128,100,113,101,45],[75,79,123,47,51,128,81,171,1],[57,17,5,71,102,57,53,41,49],[38,33,13,121,57,73,26,1,85],[41,10,67,138,77,110,90,47,114],[115,21,2,10,102,255,166,23,6],[101,29,16,10,85,128,101,196,26],[57,18,10,102,102,213,34,20,43],[117,20,15,36,163,128,68,1,26]],[[102,61,71,37,34,53,31,243,192],[69,60,71,38,73,119,28,222,37],[68,45,128,34,1,47,11,245,171],[62,17,19,70,146,85,55,62,70],[37,43,37,154,100,163,85,160,1],[63,9,92,136,28,64,32,201,85],[75,15,9,9,64,255,184,119,16],[86,6,28,5,64,255,25,248,1],[56,8,17,132,137,255,55,116,128],[58,15,20,82,135,57,26,121,40]],[[164,50,31,137,154,133,25,35,218],[51,103,44,131,131,123,31,6,158],[86,40,64,135,148,224,45,183,128],[22,26,17,131,240,154,14,1,209],[45,16,21,91,64,222,7,1,197],[56,21,39,155,60,138,23,102,213],[83,12,13,54,192,255,68,47,28],[85,26,85,85,128,128,32,146,171],[18,11,7,63,144,171,4,4,246],[35,27,10,146,174,171,12,26,128]],[[190,80,35,99,180,80,126,54,45],[85,126,47,87,176,51,41,20,32],[101,75,128,139,118,146,116,128,85],[56,41,15,176,236,85,37,9,62],[71,30,17,119,118,255,17,18,138],[101,38,60,138,55,70,43,26,142],[146,36,19,30,171,255,97,27,20],[138,45,61,62,219,1,81,188,64],[32,41,20,117,151,142,20,21,163],[112,19,12,61,195,128,48,4,24]]],uo=[[[[255,255,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255]],[[176,246,255,255,255,255,255,255,255,255,255],[223,241,252,255,255,255,255,255,255,255,255],[249,253,253,255,255,255,255,255,255,255,255]],[[255,244,252,255,255,255,255,255,255,255,255],[234,254,254,255,255,255,255,255,255,255,255],[253,255,255,255,255,255,255,255,255,255,255]],[[255,246,254,255,255,255,255,255,255,255,255],[239,253,254,255,255,255,255,255,255,255,255],[254,255,254,255,255,255,255,255,255,255,255]],[[255,248,254,255,255,255,255,255,255,255,255],[251,255,254,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255]],[[255,253,254,255,255,255,255,255,255,255,255],[251,254,254,255,255,255,255,255,255,255,255],[254,255,254,255,255,255,255,255,255,255,255]],[[255,254,253,255,254,255,255,255,255,255,255],[250,255,254,255,254,255,255,255,255,255,255],[254,255,255,255,255,255,255,255,255,255,255]],[[255,255,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255]]],[[[217,255,255,255,255,255,255,255,255,255,255],[225,252,241,253,255,255,254,255,255,255,255],[234,250,241,250,253,255,253,254,255,255,255]],[[255,254,255,255,255,255,255,255,255,255,255],[223,254,254,255,255,255,255,255,255,255,255],[238,253,254,254,255,255,255,255,255,255,255]],[[255,248,254,255,255,255,255,255,255,255,255],[249,254,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255]],[[255,253,255,255,255,255,255,255,255,255,255],[247,254,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255]],[[255,253,254,255,255,255,255,255,255,255,255],[252,255,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255]],[[255,254,254,255,255,255,255,255,255,255,255],[253,255,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255]],[[255,254,253,255,255,255,255,255,255,255,255],[250,255,255,255,255,255,255,255,255,255,255],[254,255,255,255,255,255,255,255,255,255,255]],[[255,255,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255]]],[[[186,251,250,255,255,255,255,255,255,255,255],[234,251,244,254,255,255,255,255,255,255,255],[251,251,243,253,254,255,254,255,255,255,255]],[[255,253,254,255,255,255,255,255,255,255,255],[236,253,254,255,255,255,255,255,255,255,255],[251,253,253,254,254,255,255,255,255,255,255]],[[255,254,254,255,255,255,255,255,255,255,255],[254,254,254,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255]],[[255,254,255,255,255,255,255,255,255,255,255],[254,254,255,255,255,255,255,255,255,255,255],[254,255,255,255,255,255,255,255,255,255,255]],[[255,255,255,255,255,255,255,255,255,255,255],[254,255,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255]],[[255,255,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255]],[[255,255,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255]],[[255,255,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255]]],[[[248,255,255,255,255,255,255,255,255,255,255],[250,254,252,254,255,255,255,255,255,255,255],[248,254,249,253,255,255,255,255,255,255,255]],[[255,253,253,255,255,255,255,255,255,255,255],[246,253,253,255,255,255,255,255,255,255,255],[252,254,251,254,254,255,255,255,255,255,255]],[[255,254,252,255,255,255,255,255,255,255,255],[248,254,253,255,255,255,255,255,255,255,255],[253,255,254,254,255,255,255,255,255,255,255]],[[255,251,254,255,255,255,255,255,255,255,255],[245,251,254,255,255,255,255,255,255,255,255],[253,253,254,255,255,255,255,255,255,255,255]],[[255,251,253,255,255,255,255,255,255,255,255],[252,253,254,255,255,255,255,255,255,255,255],[255,254,255,255,255,255,255,255,255,255,255]],[[255,252,255,255,255,255,255,255,255,255,255],[249,255,254,255,255,255,255,255,255,255,255],[255,255,254,255,255,255,255,255,255,255,255]],[[255,255,253,255,255,255,255,255,255,255,255],[250,255,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255]],[[255,255,255,255,255,255,255,255,255,255,255],[254,255,255,255,255,255,255,255,255,255,255],[255,255,255,255,255,255,255,255,255,255,255]]]],co=[0,1,2,3,6,4,5,6,6,6,6,6,6,6,6,7,0],lo=[],fo=[],ho=[],po=1,mo=2,go=[],yo=[];gr("UpsampleRgbLinePair",jr,3),gr("UpsampleBgrLinePair",_r,3),gr("UpsampleRgbaLinePair",Qr,4),gr("UpsampleBgraLinePair",Nr,4),gr("UpsampleArgbLinePair",Er,4),gr("UpsampleRgba4444LinePair",xr,2),gr("UpsampleRgb565LinePair",Cr,2);var vo=e.UpsampleRgbLinePair,wo=e.UpsampleBgrLinePair,bo=e.UpsampleRgbaLinePair,Bo=e.UpsampleBgraLinePair,jo=e.UpsampleArgbLinePair,_o=e.UpsampleRgba4444LinePair,Co=e.UpsampleRgb565LinePair,xo=16,Eo=1<<xo-1,No=-227,Qo=482,Fo=6,Uo=(256<<Fo)-1,So=0,Lo=s(256),To=s(256),Ho=s(256),Io=s(256),Po=s(Qo-No),Oo=s(Qo-No);Fr("YuvToRgbRow",jr,3),Fr("YuvToBgrRow",_r,3),Fr("YuvToRgbaRow",Qr,4),Fr("YuvToBgraRow",Nr,4),Fr("YuvToArgbRow",Er,4),Fr("YuvToRgba4444Row",xr,2),Fr("YuvToRgb565Row",Cr,2);var ko=[0,4,8,12,128,132,136,140,256,260,264,268,384,388,392,396],Ro=[0,2,8],Mo=[8,7,6,4,4,2,2,2,1,1,1,1],Do=1;this.WebPDecodeRGBA=function(e,r,n,o,s){var i=Pn,a=new rr,A=new ie;a.ba=A,A.S=i,A.width=[A.width],A.height=[A.height];var u=A.width,c=A.height,l=new ae;if(null==l||null==e)var d=2;else t(null!=l),d=Tr(e,r,n,l.width,l.height,l.Pd,l.Qd,l.format,null);if(0!=d?u=0:(null!=u&&(u[0]=l.width[0]),null!=c&&(c[0]=l.height[0]),u=1),u){A.width=A.width[0],A.height=A.height[0],null!=o&&(o[0]=A.width),null!=s&&(s[0]=A.height);e:{if(o=new qe,(s=new nr).data=e,s.w=r,s.ha=n,s.kd=1,r=[0],t(null!=s),(0==(e=Tr(s.data,s.w,s.ha,null,null,null,r,null,s))||7==e)&&r[0]&&(e=4),0==(r=e)){if(t(null!=a),o.data=s.data,o.w=s.w+s.offset,o.ha=s.ha-s.offset,o.put=fe,o.ac=de,o.bc=he,o.ma=a,s.xa){if(null==(e=Ne())){a=1;break e}if(function(e,r){var n=[0],o=[0],s=[0];t:for(;;){if(null==e)return 0;if(null==r)return e.a=2,0;if(e.l=r,e.a=0,g(e.m,r.data,r.w,r.ha),!pe(e.m,n,o,s)){e.a=3;break t}if(e.xb=mo,r.width=n[0],r.height=o[0],!Qe(n[0],o[0],1,e,null))break t;return 1}return t(0!=e.a),0}(e,o)){if(o=0==(r=Pr(o.width,o.height,a.Oa,a.ba))){t:{o=e;r:for(;;){if(null==o){o=0;break t}if(t(null!=o.s.yc),t(null!=o.s.Ya),t(0<o.s.Wb),t(null!=(n=o.l)),t(null!=(s=n.ma)),0!=o.xb){if(o.ca=s.ba,o.tb=s.tb,t(null!=o.ca),!Hr(s.Oa,n,kn)){o.a=2;break r}if(!Fe(o,n.width))break r;if(n.da)break r;if((n.da||ne(o.ca.S))&&mr(),11>o.ca.S||(alert("todo:WebPInitConvertARGBToYUV"),null!=o.ca.f.kb.F&&mr()),o.Pb&&0<o.s.ua&&null==o.s.vb.X&&!L(o.s.vb,o.s.Wa.Xa)){o.a=1;break r}o.xb=0}if(!xe(o,o.V,o.Ba,o.c,o.i,n.o,Be))break r;s.Dc=o.Ma,o=1;break t}t(0!=o.a),o=0}o=!o}o&&(r=e.a)}else r=e.a}else{if(null==(e=new Ge)){a=1;break e}if(e.Fa=s.na,e.P=s.P,e.qc=s.Sa,Je(e,o)){if(0==(r=Pr(o.width,o.height,a.Oa,a.ba))){if(e.Aa=0,n=a.Oa,t(null!=(s=e)),null!=n){if(0<(u=0>(u=n.Md)?0:100<u?255:255*u/100)){for(c=l=0;4>c;++c)12>(d=s.pb[c]).lc&&(d.ia=u*Mo[0>d.lc?0:d.lc]>>3),l|=d.ia;l&&(alert("todo:VP8InitRandom"),s.ia=1)}s.Ga=n.Id,100<s.Ga?s.Ga=100:0>s.Ga&&(s.Ga=0)}$e(e,o)||(r=e.a)}}else r=e.a}0==r&&null!=a.Oa&&a.Oa.fd&&(r=Ir(a.ba))}a=r}i=0!=a?null:11>i?A.f.RGBA.eb:A.f.kb.y}else i=null;return i};var Ko=[3,4,3,4,4,2,2,4,4,4,2,1,1]});var l=[0],d=[0],f=[],h=new $e,p=e,m=function(e,t){var r={},n=0,o=!1,s=0,i=0;if(r.frames=[],!function(e,t,r,n){for(var o=0;o<4;o++)if(e[t+o]!="RIFF".charCodeAt(o))return!0;return!1}(e,t)){var a,l;for(c(e,t+=4),t+=8;t<e.length;){var d=A(e,t),f=c(e,t+=4);t+=4;var h=f+(1&f);switch(d){case"VP8 ":case"VP8L":void 0===r.frames[n]&&(r.frames[n]={}),(g=r.frames[n]).src_off=o?i:t-8,g.src_size=s+f+8,n++,o&&(o=!1,s=0,i=0);break;case"VP8X":(g=r.header={}).feature_flags=e[t];var p=t+4;g.canvas_width=1+u(e,p),p+=3,g.canvas_height=1+u(e,p),p+=3;break;case"ALPH":o=!0,s=h+8,i=t-8;break;case"ANIM":(g=r.header).bgcolor=c(e,t),p=t+4,g.loop_count=(a=e)[(l=p)+0]<<0|a[l+1]<<8,p+=2;break;case"ANMF":var m,g;(g=r.frames[n]={}).offset_x=2*u(e,t),t+=3,g.offset_y=2*u(e,t),t+=3,g.width=1+u(e,t),t+=3,g.height=1+u(e,t),t+=3,g.duration=u(e,t),t+=3,m=e[t++],g.dispose=1&m,g.blend=m>>1&1}"ANMF"!=d&&(t+=h)}return r}}(p,0);m.response=p,m.rgbaoutput=!0,m.dataurl=!1;var g=m.header?m.header:null,y=m.frames?m.frames:null;if(g){g.loop_counter=g.loop_count,l=[g.canvas_height],d=[g.canvas_width];for(var v=0;v<y.length&&0!=y[v].blend;v++);}var w=y[0],b=h.WebPDecodeRGBA(p,w.src_off,w.src_size,d,l);w.rgba=b,w.imgwidth=d[0],w.imgheight=l[0];for(var B=0;B<d[0]*l[0]*4;B++)f[B]=b[B];return this.width=d,this.height=l,this.data=f,this}!function(e){var t=function(t,o,u,c){var l=4,d=i;switch(c){case e.image_compression.FAST:l=1,d=s;break;case e.image_compression.MEDIUM:l=6,d=a;break;case e.image_compression.SLOW:l=9,d=A}t=r(t,o,u,d);var f=(0,n.zlibSync)(t,{level:l});return e.__addimage__.arrayBufferToBinaryString(f)},r=function(e,t,r,n){for(var o,s,i,a=e.length/t,A=new Uint8Array(e.length+a),u=c(),d=0;d<a;d+=1){if(i=d*t,o=e.subarray(i,i+t),n)A.set(n(o,r,s),i+d);else{for(var f,h=u.length,p=[];f<h;f+=1)p[f]=u[f](o,r,s);var m=l(p.concat());A.set(p[m],i+d)}s=o}return A},o=function(e){var t=Array.apply([],e);return t.unshift(0),t},s=function(e,t){var r,n=[],o=e.length;n[0]=1;for(var s=0;s<o;s+=1)r=e[s-t]||0,n[s+1]=e[s]-r+256&255;return n},i=function(e,t,r){var n,o=[],s=e.length;o[0]=2;for(var i=0;i<s;i+=1)n=r&&r[i]||0,o[i+1]=e[i]-n+256&255;return o},a=function(e,t,r){var n,o,s=[],i=e.length;s[0]=3;for(var a=0;a<i;a+=1)n=e[a-t]||0,o=r&&r[a]||0,s[a+1]=e[a]+256-(n+o>>>1)&255;return s},A=function(e,t,r){var n,o,s,i,a=[],A=e.length;a[0]=4;for(var c=0;c<A;c+=1)n=e[c-t]||0,o=r&&r[c]||0,s=r&&r[c-t]||0,i=u(n,o,s),a[c+1]=e[c]-i+256&255;return a},u=function(e,t,r){if(e===t&&t===r)return e;var n=Math.abs(t-r),o=Math.abs(e-r),s=Math.abs(e+t-r-r);return n<=o&&n<=s?e:o<=s?t:r},c=function(){return[o,s,i,a,A]},l=function(e){var t=e.map((function(e){return e.reduce((function(e,t){return e+Math.abs(t)}),0)}));return t.indexOf(Math.min.apply(null,t))};e.processPNG=function(r,o,s,i){var a,A,u,c,l,d,f,h,p,m,g,y,v,w,b,B=this.decode.FLATE_DECODE,j="";if(this.__addimage__.isArrayBuffer(r)&&(r=new Uint8Array(r)),this.__addimage__.isArrayBufferView(r)){if(r=(u=new Xe(r)).imgData,A=u.bits,a=u.colorSpace,l=u.colors,-1!==[4,6].indexOf(u.colorType)){if(8===u.bits){p=(h=32==u.pixelBitlength?new Uint32Array(u.decodePixels().buffer):16==u.pixelBitlength?new Uint16Array(u.decodePixels().buffer):new Uint8Array(u.decodePixels().buffer)).length,g=new Uint8Array(p*u.colors),m=new Uint8Array(p);var _,C=u.pixelBitlength-u.bits;for(w=0,b=0;w<p;w++){for(v=h[w],_=0;_<C;)g[b++]=v>>>_&255,_+=u.bits;m[w]=v>>>_&255}}if(16===u.bits){p=(h=new Uint32Array(u.decodePixels().buffer)).length,g=new Uint8Array(p*(32/u.pixelBitlength)*u.colors),m=new Uint8Array(p*(32/u.pixelBitlength)),y=u.colors>1,w=0,b=0;for(var x=0;w<p;)v=h[w++],g[b++]=v>>>0&255,y&&(g[b++]=v>>>16&255,v=h[w++],g[b++]=v>>>0&255),m[x++]=v>>>16&255;A=8}i!==e.image_compression.NONE&&"function"==typeof n.zlibSync?(r=t(g,u.width*u.colors,u.colors,i),f=t(m,u.width,1,i)):(r=g,f=m,B=void 0)}if(3===u.colorType&&(a=this.color_spaces.INDEXED,d=u.palette,u.transparency.indexed)){var E=u.transparency.indexed,N=0;for(w=0,p=E.length;w<p;++w)N+=E[w];if((N/=255)==p-1&&-1!==E.indexOf(0))c=[E.indexOf(0)];else if(N!==p){for(h=u.decodePixels(),m=new Uint8Array(h.length),w=0,p=h.length;w<p;w++)m[w]=E[h[w]];f=t(m,u.width,1)}}var Q=function(t){var r;switch(t){case e.image_compression.FAST:r=11;break;case e.image_compression.MEDIUM:r=13;break;case e.image_compression.SLOW:r=14;break;default:r=12}return r}(i);return B===this.decode.FLATE_DECODE&&(j="/Predictor "+Q+" "),j+="/Colors "+l+" /BitsPerComponent "+A+" /Columns "+u.width,(this.__addimage__.isArrayBuffer(r)||this.__addimage__.isArrayBufferView(r))&&(r=this.__addimage__.arrayBufferToBinaryString(r)),(f&&this.__addimage__.isArrayBuffer(f)||this.__addimage__.isArrayBufferView(f))&&(f=this.__addimage__.arrayBufferToBinaryString(f)),{alias:s,data:r,index:o,filter:B,decodeParameters:j,transparency:c,palette:d,sMask:f,predictor:Q,width:u.width,height:u.height,bitsPerComponent:A,colorSpace:a}}}}(H.API),function(e){e.processGIF89A=function(t,r,n,o){var s=new We(t),i=s.width,a=s.height,A=[];s.decodeAndBlitFrameRGBA(0,A);var u={data:A,width:i,height:a},c=new Ye(100).encode(u,100);return e.processJPEG.call(this,c,r,n,o)},e.processGIF87A=e.processGIF89A}(H.API),Ze.prototype.parseHeader=function(){if(this.fileSize=this.datav.getUint32(this.pos,!0),this.pos+=4,this.reserved=this.datav.getUint32(this.pos,!0),this.pos+=4,this.offset=this.datav.getUint32(this.pos,!0),this.pos+=4,this.headerSize=this.datav.getUint32(this.pos,!0),this.pos+=4,this.width=this.datav.getUint32(this.pos,!0),this.pos+=4,this.height=this.datav.getInt32(this.pos,!0),this.pos+=4,this.planes=this.datav.getUint16(this.pos,!0),this.pos+=2,this.bitPP=this.datav.getUint16(this.pos,!0),this.pos+=2,this.compress=this.datav.getUint32(this.pos,!0),this.pos+=4,this.rawSize=this.datav.getUint32(this.pos,!0),this.pos+=4,this.hr=this.datav.getUint32(this.pos,!0),this.pos+=4,this.vr=this.datav.getUint32(this.pos,!0),this.pos+=4,this.colors=this.datav.getUint32(this.pos,!0),this.pos+=4,this.importantColors=this.datav.getUint32(this.pos,!0),this.pos+=4,16===this.bitPP&&this.is_with_alpha&&(this.bitPP=15),this.bitPP<15){var e=0===this.colors?1<<this.bitPP:this.colors;this.palette=new Array(e);for(var t=0;t<e;t++){var r=this.datav.getUint8(this.pos++,!0),n=this.datav.getUint8(this.pos++,!0),o=this.datav.getUint8(this.pos++,!0),s=this.datav.getUint8(this.pos++,!0);this.palette[t]={red:o,green:n,blue:r,quad:s}}}this.height<0&&(this.height*=-1,this.bottom_up=!1)},Ze.prototype.parseBGR=function(){this.pos=this.offset;try{var e="bit"+this.bitPP,t=this.width*this.height*4;this.data=new Uint8Array(t),this[e]()}catch(e){i.log("bit decode error:"+e)}},Ze.prototype.bit1=function(){var e,t=Math.ceil(this.width/8),r=t%4;for(e=this.height-1;e>=0;e--){for(var n=this.bottom_up?e:this.height-1-e,o=0;o<t;o++)for(var s=this.datav.getUint8(this.pos++,!0),i=n*this.width*4+8*o*4,a=0;a<8&&8*o+a<this.width;a++){var A=this.palette[s>>7-a&1];this.data[i+4*a]=A.blue,this.data[i+4*a+1]=A.green,this.data[i+4*a+2]=A.red,this.data[i+4*a+3]=255}0!==r&&(this.pos+=4-r)}},Ze.prototype.bit4=function(){for(var e=Math.ceil(this.width/2),t=e%4,r=this.height-1;r>=0;r--){for(var n=this.bottom_up?r:this.height-1-r,o=0;o<e;o++){var s=this.datav.getUint8(this.pos++,!0),i=n*this.width*4+2*o*4,a=s>>4,A=15&s,u=this.palette[a];if(this.data[i]=u.blue,this.data[i+1]=u.green,this.data[i+2]=u.red,this.data[i+3]=255,2*o+1>=this.width)break;u=this.palette[A],this.data[i+4]=u.blue,this.data[i+4+1]=u.green,this.data[i+4+2]=u.red,this.data[i+4+3]=255}0!==t&&(this.pos+=4-t)}},Ze.prototype.bit8=function(){for(var e=this.width%4,t=this.height-1;t>=0;t--){for(var r=this.bottom_up?t:this.height-1-t,n=0;n<this.width;n++){var o=this.datav.getUint8(this.pos++,!0),s=r*this.width*4+4*n;if(o<this.palette.length){var i=this.palette[o];this.data[s]=i.red,this.data[s+1]=i.green,this.data[s+2]=i.blue,this.data[s+3]=255}else this.data[s]=255,this.data[s+1]=255,this.data[s+2]=255,this.data[s+3]=255}0!==e&&(this.pos+=4-e)}},Ze.prototype.bit15=function(){for(var e=this.width%3,t=parseInt("11111",2),r=this.height-1;r>=0;r--){for(var n=this.bottom_up?r:this.height-1-r,o=0;o<this.width;o++){var s=this.datav.getUint16(this.pos,!0);this.pos+=2;var i=(s&t)/t*255|0,a=(s>>5&t)/t*255|0,A=(s>>10&t)/t*255|0,u=s>>15?255:0,c=n*this.width*4+4*o;this.data[c]=A,this.data[c+1]=a,this.data[c+2]=i,this.data[c+3]=u}this.pos+=e}},Ze.prototype.bit16=function(){for(var e=this.width%3,t=parseInt("11111",2),r=parseInt("111111",2),n=this.height-1;n>=0;n--){for(var o=this.bottom_up?n:this.height-1-n,s=0;s<this.width;s++){var i=this.datav.getUint16(this.pos,!0);this.pos+=2;var a=(i&t)/t*255|0,A=(i>>5&r)/r*255|0,u=(i>>11)/t*255|0,c=o*this.width*4+4*s;this.data[c]=u,this.data[c+1]=A,this.data[c+2]=a,this.data[c+3]=255}this.pos+=e}},Ze.prototype.bit24=function(){for(var e=this.height-1;e>=0;e--){for(var t=this.bottom_up?e:this.height-1-e,r=0;r<this.width;r++){var n=this.datav.getUint8(this.pos++,!0),o=this.datav.getUint8(this.pos++,!0),s=this.datav.getUint8(this.pos++,!0),i=t*this.width*4+4*r;this.data[i]=s,this.data[i+1]=o,this.data[i+2]=n,this.data[i+3]=255}this.pos+=this.width%4}},Ze.prototype.bit32=function(){for(var e=this.height-1;e>=0;e--)for(var t=this.bottom_up?e:this.height-1-e,r=0;r<this.width;r++){var n=this.datav.getUint8(this.pos++,!0),o=this.datav.getUint8(this.pos++,!0),s=this.datav.getUint8(this.pos++,!0),i=this.datav.getUint8(this.pos++,!0),a=t*this.width*4+4*r;this.data[a]=s,this.data[a+1]=o,this.data[a+2]=n,this.data[a+3]=i}},Ze.prototype.getData=function(){return this.data},function(e){e.processBMP=function(t,r,n,o){var s=new Ze(t,!1),i=s.width,a=s.height,A={data:s.getData(),width:i,height:a},u=new Ye(100).encode(A,100);return e.processJPEG.call(this,u,r,n,o)}}(H.API),$e.prototype.getData=function(){return this.data},function(e){e.processWEBP=function(t,r,n,o){var s=new $e(t,!1),i=s.width,a=s.height,A={data:s.getData(),width:i,height:a},u=new Ye(100).encode(A,100);return e.processJPEG.call(this,u,r,n,o)}}(H.API),H.API.setLanguage=function(e){return void 0===this.internal.languageSettings&&(this.internal.languageSettings={},this.internal.languageSettings.isSubscribed=!1),void 0!=={af:"Afrikaans",sq:"Albanian",ar:"Arabic (Standard)","ar-DZ":"Arabic (Algeria)","ar-BH":"Arabic (Bahrain)","ar-EG":"Arabic (Egypt)","ar-IQ":"Arabic (Iraq)","ar-JO":"Arabic (Jordan)","ar-KW":"Arabic (Kuwait)","ar-LB":"Arabic (Lebanon)","ar-LY":"Arabic (Libya)","ar-MA":"Arabic (Morocco)","ar-OM":"Arabic (Oman)","ar-QA":"Arabic (Qatar)","ar-SA":"Arabic (Saudi Arabia)","ar-SY":"Arabic (Syria)","ar-TN":"Arabic (Tunisia)","ar-AE":"Arabic (U.A.E.)","ar-YE":"Arabic (Yemen)",an:"Aragonese",hy:"Armenian",as:"Assamese",ast:"Asturian",az:"Azerbaijani",eu:"Basque",be:"Belarusian",bn:"Bengali",bs:"Bosnian",br:"Breton",bg:"Bulgarian",my:"Burmese",ca:"Catalan",ch:"Chamorro",ce:"Chechen",zh:"Chinese","zh-HK":"Chinese (Hong Kong)","zh-CN":"Chinese (PRC)","zh-SG":"Chinese (Singapore)","zh-TW":"Chinese (Taiwan)",cv:"Chuvash",co:"Corsican",cr:"Cree",hr:"Croatian",cs:"Czech",da:"Danish",nl:"Dutch (Standard)","nl-BE":"Dutch (Belgian)",en:"English","en-AU":"English (Australia)","en-BZ":"English (Belize)","en-CA":"English (Canada)","en-IE":"English (Ireland)","en-JM":"English (Jamaica)","en-NZ":"English (New Zealand)","en-PH":"English (Philippines)","en-ZA":"English (South Africa)","en-TT":"English (Trinidad & Tobago)","en-GB":"English (United Kingdom)","en-US":"English (United States)","en-ZW":"English (Zimbabwe)",eo:"Esperanto",et:"Estonian",fo:"Faeroese",fj:"Fijian",fi:"Finnish",fr:"French (Standard)","fr-BE":"French (Belgium)","fr-CA":"French (Canada)","fr-FR":"French (France)","fr-LU":"French (Luxembourg)","fr-MC":"French (Monaco)","fr-CH":"French (Switzerland)",fy:"Frisian",fur:"Friulian",gd:"Gaelic (Scots)","gd-IE":"Gaelic (Irish)",gl:"Galacian",ka:"Georgian",de:"German (Standard)","de-AT":"German (Austria)","de-DE":"German (Germany)","de-LI":"German (Liechtenstein)","de-LU":"German (Luxembourg)","de-CH":"German (Switzerland)",el:"Greek",gu:"Gujurati",ht:"Haitian",he:"Hebrew",hi:"Hindi",hu:"Hungarian",is:"Icelandic",id:"Indonesian",iu:"Inuktitut",ga:"Irish",it:"Italian (Standard)","it-CH":"Italian (Switzerland)",ja:"Japanese",kn:"Kannada",ks:"Kashmiri",kk:"Kazakh",km:"Khmer",ky:"Kirghiz",tlh:"Klingon",ko:"Korean","ko-KP":"Korean (North Korea)","ko-KR":"Korean (South Korea)",la:"Latin",lv:"Latvian",lt:"Lithuanian",lb:"Luxembourgish",mk:"FYRO Macedonian",ms:"Malay",ml:"Malayalam",mt:"Maltese",mi:"Maori",mr:"Marathi",mo:"Moldavian",nv:"Navajo",ng:"Ndonga",ne:"Nepali",no:"Norwegian",nb:"Norwegian (Bokmal)",nn:"Norwegian (Nynorsk)",oc:"Occitan",or:"Oriya",om:"Oromo",fa:"Persian","fa-IR":"Persian/Iran",pl:"Polish",pt:"Portuguese","pt-BR":"Portuguese (Brazil)",pa:"Punjabi","pa-IN":"Punjabi (India)","pa-PK":"Punjabi (Pakistan)",qu:"Quechua",rm:"Rhaeto-Romanic",ro:"Romanian","ro-MO":"Romanian (Moldavia)",ru:"Russian","ru-MO":"Russian (Moldavia)",sz:"Sami (Lappish)",sg:"Sango",sa:"Sanskrit",sc:"Sardinian",sd:"Sindhi",si:"Singhalese",sr:"Serbian",sk:"Slovak",sl:"Slovenian",so:"Somani",sb:"Sorbian",es:"Spanish","es-AR":"Spanish (Argentina)","es-BO":"Spanish (Bolivia)","es-CL":"Spanish (Chile)","es-CO":"Spanish (Colombia)","es-CR":"Spanish (Costa Rica)","es-DO":"Spanish (Dominican Republic)","es-EC":"Spanish (Ecuador)","es-SV":"Spanish (El Salvador)","es-GT":"Spanish (Guatemala)","es-HN":"Spanish (Honduras)","es-MX":"Spanish (Mexico)","es-NI":"Spanish (Nicaragua)","es-PA":"Spanish (Panama)","es-PY":"Spanish (Paraguay)","es-PE":"Spanish (Peru)","es-PR":"Spanish (Puerto Rico)","es-ES":"Spanish (Spain)","es-UY":"Spanish (Uruguay)","es-VE":"Spanish (Venezuela)",sx:"Sutu",sw:"Swahili",sv:"Swedish","sv-FI":"Swedish (Finland)","sv-SV":"Swedish (Sweden)",ta:"Tamil",tt:"Tatar",te:"Teluga",th:"Thai",tig:"Tigre",ts:"Tsonga",tn:"Tswana",tr:"Turkish",tk:"Turkmen",uk:"Ukrainian",hsb:"Upper Sorbian",ur:"Urdu",ve:"Venda",vi:"Vietnamese",vo:"Volapuk",wa:"Walloon",cy:"Welsh",xh:"Xhosa",ji:"Yiddish",zu:"Zulu"}[e]&&(this.internal.languageSettings.languageCode=e,!1===this.internal.languageSettings.isSubscribed&&(this.internal.events.subscribe("putCatalog",(function(){this.internal.write("/Lang ("+this.internal.languageSettings.languageCode+")")})),this.internal.languageSettings.isSubscribed=!0)),this},Ke=H.API,ze=Ke.getCharWidthsArray=function(e,t){var r,n,o=(t=t||{}).font||this.internal.getFont(),s=t.fontSize||this.internal.getFontSize(),i=t.charSpace||this.internal.getCharSpace(),a=t.widths?t.widths:o.metadata.Unicode.widths,A=a.fof?a.fof:1,u=t.kerning?t.kerning:o.metadata.Unicode.kerning,c=u.fof?u.fof:1,l=!1!==t.doKerning,d=0,f=e.length,h=0,p=a[0]||A,m=[];for(r=0;r<f;r++)n=e.charCodeAt(r),"function"==typeof o.metadata.widthOfString?m.push((o.metadata.widthOfGlyph(o.metadata.characterToGlyph(n))+i*(1e3/s)||0)/1e3):(d=l&&"object"==typeof u[n]&&!isNaN(parseInt(u[n][h],10))?u[n][h]/c:0,m.push((a[n]||p)/A+d)),h=n;return m},Ve=Ke.getStringUnitWidth=function(e,t){var r=(t=t||{}).fontSize||this.internal.getFontSize(),n=t.font||this.internal.getFont(),o=t.charSpace||this.internal.getCharSpace();return Ke.processArabic&&(e=Ke.processArabic(e)),"function"==typeof n.metadata.widthOfString?n.metadata.widthOfString(e,r,o)/r:ze.apply(this,arguments).reduce((function(e,t){return e+t}),0)},qe=function(e,t,r,n){for(var o=[],s=0,i=e.length,a=0;s!==i&&a+t[s]<r;)a+=t[s],s++;o.push(e.slice(0,s));var A=s;for(a=0;s!==i;)a+t[s]>n&&(o.push(e.slice(A,s)),a=0,A=s),a+=t[s],s++;return A!==s&&o.push(e.slice(A,s)),o},Ge=function(e,t,r){r||(r={});var n,o,s,i,a,A,u,c=[],l=[c],d=r.textIndent||0,f=0,h=0,p=e.split(" "),m=ze.apply(this,[" ",r])[0];if(A=-1===r.lineIndent?p[0].length+2:r.lineIndent||0){var g=Array(A).join(" "),y=[];p.map((function(e){(e=e.split(/\s*\n/)).length>1?y=y.concat(e.map((function(e,t){return(t&&e.length?"\n":"")+e}))):y.push(e[0])})),p=y,A=Ve.apply(this,[g,r])}for(s=0,i=p.length;s<i;s++){var v=0;if(n=p[s],A&&"\n"==n[0]&&(n=n.substr(1),v=1),d+f+(h=(o=ze.apply(this,[n,r])).reduce((function(e,t){return e+t}),0))>t||v){if(h>t){for(a=qe.apply(this,[n,o,t-(d+f),t]),c.push(a.shift()),c=[a.pop()];a.length;)l.push([a.shift()]);h=o.slice(n.length-(c[0]?c[0].length:0)).reduce((function(e,t){return e+t}),0)}else c=[n];l.push(c),d=h+A,f=m}else c.push(n),d+=f+h,f=m}return u=A?function(e,t){return(t?g:"")+e.join(" ")}:function(e){return e.join(" ")},l.map(u)},Ke.splitTextToSize=function(e,t,r){var n,o=(r=r||{}).fontSize||this.internal.getFontSize(),s=function(e){if(e.widths&&e.kerning)return{widths:e.widths,kerning:e.kerning};var t=this.internal.getFont(e.fontName,e.fontStyle);return t.metadata.Unicode?{widths:t.metadata.Unicode.widths||{0:1},kerning:t.metadata.Unicode.kerning||{}}:{font:t.metadata,fontSize:this.internal.getFontSize(),charSpace:this.internal.getCharSpace()}}.call(this,r);n=Array.isArray(e)?e:String(e).split(/\r?\n/);var i=1*this.internal.scaleFactor*t/o;s.textIndent=r.textIndent?1*r.textIndent*this.internal.scaleFactor/o:0,s.lineIndent=r.lineIndent;var a,A,u=[];for(a=0,A=n.length;a<A;a++)u=u.concat(Ge.apply(this,[n[a],i,s]));return u},function(e){e.__fontmetrics__=e.__fontmetrics__||{};for(var t="klmnopqrstuvwxyz",r={},n={},o=0;o<t.length;o++)r[t[o]]="0123456789abcdef"[o],n["0123456789abcdef"[o]]=t[o];var s=function(e){return"0x"+parseInt(e,10).toString(16)},i=e.__fontmetrics__.compress=function(e){var t,r,o,a,A=["{"];for(var u in e){if(t=e[u],isNaN(parseInt(u,10))?r="'"+u+"'":(u=parseInt(u,10),r=(r=s(u).slice(2)).slice(0,-1)+n[r.slice(-1)]),"number"==typeof t)t<0?(o=s(t).slice(3),a="-"):(o=s(t).slice(2),a=""),o=a+o.slice(0,-1)+n[o.slice(-1)];else{if("object"!=typeof t)throw new Error("Don't know what to do with value type "+typeof t+".");o=i(t)}A.push(r+o)}return A.push("}"),A.join("")},a=e.__fontmetrics__.uncompress=function(e){if("string"!=typeof e)throw new Error("Invalid argument passed to uncompress.");for(var t,n,o,s,i={},a=1,A=i,u=[],c="",l="",d=e.length-1,f=1;f<d;f+=1)"'"==(s=e[f])?t?(o=t.join(""),t=void 0):t=[]:t?t.push(s):"{"==s?(u.push([A,o]),A={},o=void 0):"}"==s?((n=u.pop())[0][n[1]]=A,o=void 0,A=n[0]):"-"==s?a=-1:void 0===o?r.hasOwnProperty(s)?(c+=r[s],o=parseInt(c,16)*a,a=1,c=""):c+=s:r.hasOwnProperty(s)?(l+=r[s],A[o]=parseInt(l,16)*a,a=1,o=void 0,l=""):l+=s;return i},A={codePages:["WinAnsiEncoding"],WinAnsiEncoding:a("{19m8n201n9q201o9r201s9l201t9m201u8m201w9n201x9o201y8o202k8q202l8r202m9p202q8p20aw8k203k8t203t8v203u9v2cq8s212m9t15m8w15n9w2dw9s16k8u16l9u17s9z17x8y17y9y}")},u={Unicode:{Courier:A,"Courier-Bold":A,"Courier-BoldOblique":A,"Courier-Oblique":A,Helvetica:A,"Helvetica-Bold":A,"Helvetica-BoldOblique":A,"Helvetica-Oblique":A,"Times-Roman":A,"Times-Bold":A,"Times-BoldItalic":A,"Times-Italic":A}},c={Unicode:{"Courier-Oblique":a("{'widths'{k3w'fof'6o}'kerning'{'fof'-6o}}"),"Times-BoldItalic":a("{'widths'{k3o2q4ycx2r201n3m201o6o201s2l201t2l201u2l201w3m201x3m201y3m2k1t2l2r202m2n2n3m2o3m2p5n202q6o2r1w2s2l2t2l2u3m2v3t2w1t2x2l2y1t2z1w3k3m3l3m3m3m3n3m3o3m3p3m3q3m3r3m3s3m203t2l203u2l3v2l3w3t3x3t3y3t3z3m4k5n4l4m4m4m4n4m4o4s4p4m4q4m4r4s4s4y4t2r4u3m4v4m4w3x4x5t4y4s4z4s5k3x5l4s5m4m5n3r5o3x5p4s5q4m5r5t5s4m5t3x5u3x5v2l5w1w5x2l5y3t5z3m6k2l6l3m6m3m6n2w6o3m6p2w6q2l6r3m6s3r6t1w6u1w6v3m6w1w6x4y6y3r6z3m7k3m7l3m7m2r7n2r7o1w7p3r7q2w7r4m7s3m7t2w7u2r7v2n7w1q7x2n7y3t202l3mcl4mal2ram3man3mao3map3mar3mas2lat4uau1uav3maw3way4uaz2lbk2sbl3t'fof'6obo2lbp3tbq3mbr1tbs2lbu1ybv3mbz3mck4m202k3mcm4mcn4mco4mcp4mcq5ycr4mcs4mct4mcu4mcv4mcw2r2m3rcy2rcz2rdl4sdm4sdn4sdo4sdp4sdq4sds4sdt4sdu4sdv4sdw4sdz3mek3mel3mem3men3meo3mep3meq4ser2wes2wet2weu2wev2wew1wex1wey1wez1wfl3rfm3mfn3mfo3mfp3mfq3mfr3tfs3mft3rfu3rfv3rfw3rfz2w203k6o212m6o2dw2l2cq2l3t3m3u2l17s3x19m3m}'kerning'{cl{4qu5kt5qt5rs17ss5ts}201s{201ss}201t{cks4lscmscnscoscpscls2wu2yu201ts}201x{2wu2yu}2k{201ts}2w{4qx5kx5ou5qx5rs17su5tu}2x{17su5tu5ou}2y{4qx5kx5ou5qx5rs17ss5ts}'fof'-6ofn{17sw5tw5ou5qw5rs}7t{cksclscmscnscoscps4ls}3u{17su5tu5os5qs}3v{17su5tu5os5qs}7p{17su5tu}ck{4qu5kt5qt5rs17ss5ts}4l{4qu5kt5qt5rs17ss5ts}cm{4qu5kt5qt5rs17ss5ts}cn{4qu5kt5qt5rs17ss5ts}co{4qu5kt5qt5rs17ss5ts}cp{4qu5kt5qt5rs17ss5ts}6l{4qu5ou5qw5rt17su5tu}5q{ckuclucmucnucoucpu4lu}5r{ckuclucmucnucoucpu4lu}7q{cksclscmscnscoscps4ls}6p{4qu5ou5qw5rt17sw5tw}ek{4qu5ou5qw5rt17su5tu}el{4qu5ou5qw5rt17su5tu}em{4qu5ou5qw5rt17su5tu}en{4qu5ou5qw5rt17su5tu}eo{4qu5ou5qw5rt17su5tu}ep{4qu5ou5qw5rt17su5tu}es{17ss5ts5qs4qu}et{4qu5ou5qw5rt17sw5tw}eu{4qu5ou5qw5rt17ss5ts}ev{17ss5ts5qs4qu}6z{17sw5tw5ou5qw5rs}fm{17sw5tw5ou5qw5rs}7n{201ts}fo{17sw5tw5ou5qw5rs}fp{17sw5tw5ou5qw5rs}fq{17sw5tw5ou5qw5rs}7r{cksclscmscnscoscps4ls}fs{17sw5tw5ou5qw5rs}ft{17su5tu}fu{17su5tu}fv{17su5tu}fw{17su5tu}fz{cksclscmscnscoscps4ls}}}"),"Helvetica-Bold":a("{'widths'{k3s2q4scx1w201n3r201o6o201s1w201t1w201u1w201w3m201x3m201y3m2k1w2l2l202m2n2n3r2o3r2p5t202q6o2r1s2s2l2t2l2u2r2v3u2w1w2x2l2y1w2z1w3k3r3l3r3m3r3n3r3o3r3p3r3q3r3r3r3s3r203t2l203u2l3v2l3w3u3x3u3y3u3z3x4k6l4l4s4m4s4n4s4o4s4p4m4q3x4r4y4s4s4t1w4u3r4v4s4w3x4x5n4y4s4z4y5k4m5l4y5m4s5n4m5o3x5p4s5q4m5r5y5s4m5t4m5u3x5v2l5w1w5x2l5y3u5z3r6k2l6l3r6m3x6n3r6o3x6p3r6q2l6r3x6s3x6t1w6u1w6v3r6w1w6x5t6y3x6z3x7k3x7l3x7m2r7n3r7o2l7p3x7q3r7r4y7s3r7t3r7u3m7v2r7w1w7x2r7y3u202l3rcl4sal2lam3ran3rao3rap3rar3ras2lat4tau2pav3raw3uay4taz2lbk2sbl3u'fof'6obo2lbp3xbq3rbr1wbs2lbu2obv3rbz3xck4s202k3rcm4scn4sco4scp4scq6ocr4scs4mct4mcu4mcv4mcw1w2m2zcy1wcz1wdl4sdm4ydn4ydo4ydp4ydq4yds4ydt4sdu4sdv4sdw4sdz3xek3rel3rem3ren3reo3rep3req5ter3res3ret3reu3rev3rew1wex1wey1wez1wfl3xfm3xfn3xfo3xfp3xfq3xfr3ufs3xft3xfu3xfv3xfw3xfz3r203k6o212m6o2dw2l2cq2l3t3r3u2l17s4m19m3r}'kerning'{cl{4qs5ku5ot5qs17sv5tv}201t{2ww4wy2yw}201w{2ks}201x{2ww4wy2yw}2k{201ts201xs}2w{7qs4qu5kw5os5qw5rs17su5tu7tsfzs}2x{5ow5qs}2y{7qs4qu5kw5os5qw5rs17su5tu7tsfzs}'fof'-6o7p{17su5tu5ot}ck{4qs5ku5ot5qs17sv5tv}4l{4qs5ku5ot5qs17sv5tv}cm{4qs5ku5ot5qs17sv5tv}cn{4qs5ku5ot5qs17sv5tv}co{4qs5ku5ot5qs17sv5tv}cp{4qs5ku5ot5qs17sv5tv}6l{17st5tt5os}17s{2kwclvcmvcnvcovcpv4lv4wwckv}5o{2kucltcmtcntcotcpt4lt4wtckt}5q{2ksclscmscnscoscps4ls4wvcks}5r{2ks4ws}5t{2kwclvcmvcnvcovcpv4lv4wwckv}eo{17st5tt5os}fu{17su5tu5ot}6p{17ss5ts}ek{17st5tt5os}el{17st5tt5os}em{17st5tt5os}en{17st5tt5os}6o{201ts}ep{17st5tt5os}es{17ss5ts}et{17ss5ts}eu{17ss5ts}ev{17ss5ts}6z{17su5tu5os5qt}fm{17su5tu5os5qt}fn{17su5tu5os5qt}fo{17su5tu5os5qt}fp{17su5tu5os5qt}fq{17su5tu5os5qt}fs{17su5tu5os5qt}ft{17su5tu5ot}7m{5os}fv{17su5tu5ot}fw{17su5tu5ot}}}"),Courier:a("{'widths'{k3w'fof'6o}'kerning'{'fof'-6o}}"),"Courier-BoldOblique":a("{'widths'{k3w'fof'6o}'kerning'{'fof'-6o}}"),"Times-Bold":a("{'widths'{k3q2q5ncx2r201n3m201o6o201s2l201t2l201u2l201w3m201x3m201y3m2k1t2l2l202m2n2n3m2o3m2p6o202q6o2r1w2s2l2t2l2u3m2v3t2w1t2x2l2y1t2z1w3k3m3l3m3m3m3n3m3o3m3p3m3q3m3r3m3s3m203t2l203u2l3v2l3w3t3x3t3y3t3z3m4k5x4l4s4m4m4n4s4o4s4p4m4q3x4r4y4s4y4t2r4u3m4v4y4w4m4x5y4y4s4z4y5k3x5l4y5m4s5n3r5o4m5p4s5q4s5r6o5s4s5t4s5u4m5v2l5w1w5x2l5y3u5z3m6k2l6l3m6m3r6n2w6o3r6p2w6q2l6r3m6s3r6t1w6u2l6v3r6w1w6x5n6y3r6z3m7k3r7l3r7m2w7n2r7o2l7p3r7q3m7r4s7s3m7t3m7u2w7v2r7w1q7x2r7y3o202l3mcl4sal2lam3man3mao3map3mar3mas2lat4uau1yav3maw3tay4uaz2lbk2sbl3t'fof'6obo2lbp3rbr1tbs2lbu2lbv3mbz3mck4s202k3mcm4scn4sco4scp4scq6ocr4scs4mct4mcu4mcv4mcw2r2m3rcy2rcz2rdl4sdm4ydn4ydo4ydp4ydq4yds4ydt4sdu4sdv4sdw4sdz3rek3mel3mem3men3meo3mep3meq4ser2wes2wet2weu2wev2wew1wex1wey1wez1wfl3rfm3mfn3mfo3mfp3mfq3mfr3tfs3mft3rfu3rfv3rfw3rfz3m203k6o212m6o2dw2l2cq2l3t3m3u2l17s4s19m3m}'kerning'{cl{4qt5ks5ot5qy5rw17sv5tv}201t{cks4lscmscnscoscpscls4wv}2k{201ts}2w{4qu5ku7mu5os5qx5ru17su5tu}2x{17su5tu5ou5qs}2y{4qv5kv7mu5ot5qz5ru17su5tu}'fof'-6o7t{cksclscmscnscoscps4ls}3u{17su5tu5os5qu}3v{17su5tu5os5qu}fu{17su5tu5ou5qu}7p{17su5tu5ou5qu}ck{4qt5ks5ot5qy5rw17sv5tv}4l{4qt5ks5ot5qy5rw17sv5tv}cm{4qt5ks5ot5qy5rw17sv5tv}cn{4qt5ks5ot5qy5rw17sv5tv}co{4qt5ks5ot5qy5rw17sv5tv}cp{4qt5ks5ot5qy5rw17sv5tv}6l{17st5tt5ou5qu}17s{ckuclucmucnucoucpu4lu4wu}5o{ckuclucmucnucoucpu4lu4wu}5q{ckzclzcmzcnzcozcpz4lz4wu}5r{ckxclxcmxcnxcoxcpx4lx4wu}5t{ckuclucmucnucoucpu4lu4wu}7q{ckuclucmucnucoucpu4lu}6p{17sw5tw5ou5qu}ek{17st5tt5qu}el{17st5tt5ou5qu}em{17st5tt5qu}en{17st5tt5qu}eo{17st5tt5qu}ep{17st5tt5ou5qu}es{17ss5ts5qu}et{17sw5tw5ou5qu}eu{17sw5tw5ou5qu}ev{17ss5ts5qu}6z{17sw5tw5ou5qu5rs}fm{17sw5tw5ou5qu5rs}fn{17sw5tw5ou5qu5rs}fo{17sw5tw5ou5qu5rs}fp{17sw5tw5ou5qu5rs}fq{17sw5tw5ou5qu5rs}7r{cktcltcmtcntcotcpt4lt5os}fs{17sw5tw5ou5qu5rs}ft{17su5tu5ou5qu}7m{5os}fv{17su5tu5ou5qu}fw{17su5tu5ou5qu}fz{cksclscmscnscoscps4ls}}}"),Symbol:a("{'widths'{k3uaw4r19m3m2k1t2l2l202m2y2n3m2p5n202q6o3k3m2s2l2t2l2v3r2w1t3m3m2y1t2z1wbk2sbl3r'fof'6o3n3m3o3m3p3m3q3m3r3m3s3m3t3m3u1w3v1w3w3r3x3r3y3r3z2wbp3t3l3m5v2l5x2l5z3m2q4yfr3r7v3k7w1o7x3k}'kerning'{'fof'-6o}}"),Helvetica:a("{'widths'{k3p2q4mcx1w201n3r201o6o201s1q201t1q201u1q201w2l201x2l201y2l2k1w2l1w202m2n2n3r2o3r2p5t202q6o2r1n2s2l2t2l2u2r2v3u2w1w2x2l2y1w2z1w3k3r3l3r3m3r3n3r3o3r3p3r3q3r3r3r3s3r203t2l203u2l3v1w3w3u3x3u3y3u3z3r4k6p4l4m4m4m4n4s4o4s4p4m4q3x4r4y4s4s4t1w4u3m4v4m4w3r4x5n4y4s4z4y5k4m5l4y5m4s5n4m5o3x5p4s5q4m5r5y5s4m5t4m5u3x5v1w5w1w5x1w5y2z5z3r6k2l6l3r6m3r6n3m6o3r6p3r6q1w6r3r6s3r6t1q6u1q6v3m6w1q6x5n6y3r6z3r7k3r7l3r7m2l7n3m7o1w7p3r7q3m7r4s7s3m7t3m7u3m7v2l7w1u7x2l7y3u202l3rcl4mal2lam3ran3rao3rap3rar3ras2lat4tau2pav3raw3uay4taz2lbk2sbl3u'fof'6obo2lbp3rbr1wbs2lbu2obv3rbz3xck4m202k3rcm4mcn4mco4mcp4mcq6ocr4scs4mct4mcu4mcv4mcw1w2m2ncy1wcz1wdl4sdm4ydn4ydo4ydp4ydq4yds4ydt4sdu4sdv4sdw4sdz3xek3rel3rem3ren3reo3rep3req5ter3mes3ret3reu3rev3rew1wex1wey1wez1wfl3rfm3rfn3rfo3rfp3rfq3rfr3ufs3xft3rfu3rfv3rfw3rfz3m203k6o212m6o2dw2l2cq2l3t3r3u1w17s4m19m3r}'kerning'{5q{4wv}cl{4qs5kw5ow5qs17sv5tv}201t{2wu4w1k2yu}201x{2wu4wy2yu}17s{2ktclucmucnu4otcpu4lu4wycoucku}2w{7qs4qz5k1m17sy5ow5qx5rsfsu5ty7tufzu}2x{17sy5ty5oy5qs}2y{7qs4qz5k1m17sy5ow5qx5rsfsu5ty7tufzu}'fof'-6o7p{17sv5tv5ow}ck{4qs5kw5ow5qs17sv5tv}4l{4qs5kw5ow5qs17sv5tv}cm{4qs5kw5ow5qs17sv5tv}cn{4qs5kw5ow5qs17sv5tv}co{4qs5kw5ow5qs17sv5tv}cp{4qs5kw5ow5qs17sv5tv}6l{17sy5ty5ow}do{17st5tt}4z{17st5tt}7s{fst}dm{17st5tt}dn{17st5tt}5o{ckwclwcmwcnwcowcpw4lw4wv}dp{17st5tt}dq{17st5tt}7t{5ow}ds{17st5tt}5t{2ktclucmucnu4otcpu4lu4wycoucku}fu{17sv5tv5ow}6p{17sy5ty5ow5qs}ek{17sy5ty5ow}el{17sy5ty5ow}em{17sy5ty5ow}en{5ty}eo{17sy5ty5ow}ep{17sy5ty5ow}es{17sy5ty5qs}et{17sy5ty5ow5qs}eu{17sy5ty5ow5qs}ev{17sy5ty5ow5qs}6z{17sy5ty5ow5qs}fm{17sy5ty5ow5qs}fn{17sy5ty5ow5qs}fo{17sy5ty5ow5qs}fp{17sy5ty5qs}fq{17sy5ty5ow5qs}7r{5ow}fs{17sy5ty5ow5qs}ft{17sv5tv5ow}7m{5ow}fv{17sv5tv5ow}fw{17sv5tv5ow}}}"),"Helvetica-BoldOblique":a("{'widths'{k3s2q4scx1w201n3r201o6o201s1w201t1w201u1w201w3m201x3m201y3m2k1w2l2l202m2n2n3r2o3r2p5t202q6o2r1s2s2l2t2l2u2r2v3u2w1w2x2l2y1w2z1w3k3r3l3r3m3r3n3r3o3r3p3r3q3r3r3r3s3r203t2l203u2l3v2l3w3u3x3u3y3u3z3x4k6l4l4s4m4s4n4s4o4s4p4m4q3x4r4y4s4s4t1w4u3r4v4s4w3x4x5n4y4s4z4y5k4m5l4y5m4s5n4m5o3x5p4s5q4m5r5y5s4m5t4m5u3x5v2l5w1w5x2l5y3u5z3r6k2l6l3r6m3x6n3r6o3x6p3r6q2l6r3x6s3x6t1w6u1w6v3r6w1w6x5t6y3x6z3x7k3x7l3x7m2r7n3r7o2l7p3x7q3r7r4y7s3r7t3r7u3m7v2r7w1w7x2r7y3u202l3rcl4sal2lam3ran3rao3rap3rar3ras2lat4tau2pav3raw3uay4taz2lbk2sbl3u'fof'6obo2lbp3xbq3rbr1wbs2lbu2obv3rbz3xck4s202k3rcm4scn4sco4scp4scq6ocr4scs4mct4mcu4mcv4mcw1w2m2zcy1wcz1wdl4sdm4ydn4ydo4ydp4ydq4yds4ydt4sdu4sdv4sdw4sdz3xek3rel3rem3ren3reo3rep3req5ter3res3ret3reu3rev3rew1wex1wey1wez1wfl3xfm3xfn3xfo3xfp3xfq3xfr3ufs3xft3xfu3xfv3xfw3xfz3r203k6o212m6o2dw2l2cq2l3t3r3u2l17s4m19m3r}'kerning'{cl{4qs5ku5ot5qs17sv5tv}201t{2ww4wy2yw}201w{2ks}201x{2ww4wy2yw}2k{201ts201xs}2w{7qs4qu5kw5os5qw5rs17su5tu7tsfzs}2x{5ow5qs}2y{7qs4qu5kw5os5qw5rs17su5tu7tsfzs}'fof'-6o7p{17su5tu5ot}ck{4qs5ku5ot5qs17sv5tv}4l{4qs5ku5ot5qs17sv5tv}cm{4qs5ku5ot5qs17sv5tv}cn{4qs5ku5ot5qs17sv5tv}co{4qs5ku5ot5qs17sv5tv}cp{4qs5ku5ot5qs17sv5tv}6l{17st5tt5os}17s{2kwclvcmvcnvcovcpv4lv4wwckv}5o{2kucltcmtcntcotcpt4lt4wtckt}5q{2ksclscmscnscoscps4ls4wvcks}5r{2ks4ws}5t{2kwclvcmvcnvcovcpv4lv4wwckv}eo{17st5tt5os}fu{17su5tu5ot}6p{17ss5ts}ek{17st5tt5os}el{17st5tt5os}em{17st5tt5os}en{17st5tt5os}6o{201ts}ep{17st5tt5os}es{17ss5ts}et{17ss5ts}eu{17ss5ts}ev{17ss5ts}6z{17su5tu5os5qt}fm{17su5tu5os5qt}fn{17su5tu5os5qt}fo{17su5tu5os5qt}fp{17su5tu5os5qt}fq{17su5tu5os5qt}fs{17su5tu5os5qt}ft{17su5tu5ot}7m{5os}fv{17su5tu5ot}fw{17su5tu5ot}}}"),ZapfDingbats:a("{'widths'{k4u2k1w'fof'6o}'kerning'{'fof'-6o}}"),"Courier-Bold":a("{'widths'{k3w'fof'6o}'kerning'{'fof'-6o}}"),"Times-Italic":a("{'widths'{k3n2q4ycx2l201n3m201o5t201s2l201t2l201u2l201w3r201x3r201y3r2k1t2l2l202m2n2n3m2o3m2p5n202q5t2r1p2s2l2t2l2u3m2v4n2w1t2x2l2y1t2z1w3k3m3l3m3m3m3n3m3o3m3p3m3q3m3r3m3s3m203t2l203u2l3v2l3w4n3x4n3y4n3z3m4k5w4l3x4m3x4n4m4o4s4p3x4q3x4r4s4s4s4t2l4u2w4v4m4w3r4x5n4y4m4z4s5k3x5l4s5m3x5n3m5o3r5p4s5q3x5r5n5s3x5t3r5u3r5v2r5w1w5x2r5y2u5z3m6k2l6l3m6m3m6n2w6o3m6p2w6q1w6r3m6s3m6t1w6u1w6v2w6w1w6x4s6y3m6z3m7k3m7l3m7m2r7n2r7o1w7p3m7q2w7r4m7s2w7t2w7u2r7v2s7w1v7x2s7y3q202l3mcl3xal2ram3man3mao3map3mar3mas2lat4wau1vav3maw4nay4waz2lbk2sbl4n'fof'6obo2lbp3mbq3obr1tbs2lbu1zbv3mbz3mck3x202k3mcm3xcn3xco3xcp3xcq5tcr4mcs3xct3xcu3xcv3xcw2l2m2ucy2lcz2ldl4mdm4sdn4sdo4sdp4sdq4sds4sdt4sdu4sdv4sdw4sdz3mek3mel3mem3men3meo3mep3meq4mer2wes2wet2weu2wev2wew1wex1wey1wez1wfl3mfm3mfn3mfo3mfp3mfq3mfr4nfs3mft3mfu3mfv3mfw3mfz2w203k6o212m6m2dw2l2cq2l3t3m3u2l17s3r19m3m}'kerning'{cl{5kt4qw}201s{201sw}201t{201tw2wy2yy6q-t}201x{2wy2yy}2k{201tw}2w{7qs4qy7rs5ky7mw5os5qx5ru17su5tu}2x{17ss5ts5os}2y{7qs4qy7rs5ky7mw5os5qx5ru17su5tu}'fof'-6o6t{17ss5ts5qs}7t{5os}3v{5qs}7p{17su5tu5qs}ck{5kt4qw}4l{5kt4qw}cm{5kt4qw}cn{5kt4qw}co{5kt4qw}cp{5kt4qw}6l{4qs5ks5ou5qw5ru17su5tu}17s{2ks}5q{ckvclvcmvcnvcovcpv4lv}5r{ckuclucmucnucoucpu4lu}5t{2ks}6p{4qs5ks5ou5qw5ru17su5tu}ek{4qs5ks5ou5qw5ru17su5tu}el{4qs5ks5ou5qw5ru17su5tu}em{4qs5ks5ou5qw5ru17su5tu}en{4qs5ks5ou5qw5ru17su5tu}eo{4qs5ks5ou5qw5ru17su5tu}ep{4qs5ks5ou5qw5ru17su5tu}es{5ks5qs4qs}et{4qs5ks5ou5qw5ru17su5tu}eu{4qs5ks5qw5ru17su5tu}ev{5ks5qs4qs}ex{17ss5ts5qs}6z{4qv5ks5ou5qw5ru17su5tu}fm{4qv5ks5ou5qw5ru17su5tu}fn{4qv5ks5ou5qw5ru17su5tu}fo{4qv5ks5ou5qw5ru17su5tu}fp{4qv5ks5ou5qw5ru17su5tu}fq{4qv5ks5ou5qw5ru17su5tu}7r{5os}fs{4qv5ks5ou5qw5ru17su5tu}ft{17su5tu5qs}fu{17su5tu5qs}fv{17su5tu5qs}fw{17su5tu5qs}}}"),"Times-Roman":a("{'widths'{k3n2q4ycx2l201n3m201o6o201s2l201t2l201u2l201w2w201x2w201y2w2k1t2l2l202m2n2n3m2o3m2p5n202q6o2r1m2s2l2t2l2u3m2v3s2w1t2x2l2y1t2z1w3k3m3l3m3m3m3n3m3o3m3p3m3q3m3r3m3s3m203t2l203u2l3v1w3w3s3x3s3y3s3z2w4k5w4l4s4m4m4n4m4o4s4p3x4q3r4r4s4s4s4t2l4u2r4v4s4w3x4x5t4y4s4z4s5k3r5l4s5m4m5n3r5o3x5p4s5q4s5r5y5s4s5t4s5u3x5v2l5w1w5x2l5y2z5z3m6k2l6l2w6m3m6n2w6o3m6p2w6q2l6r3m6s3m6t1w6u1w6v3m6w1w6x4y6y3m6z3m7k3m7l3m7m2l7n2r7o1w7p3m7q3m7r4s7s3m7t3m7u2w7v3k7w1o7x3k7y3q202l3mcl4sal2lam3man3mao3map3mar3mas2lat4wau1vav3maw3say4waz2lbk2sbl3s'fof'6obo2lbp3mbq2xbr1tbs2lbu1zbv3mbz2wck4s202k3mcm4scn4sco4scp4scq5tcr4mcs3xct3xcu3xcv3xcw2l2m2tcy2lcz2ldl4sdm4sdn4sdo4sdp4sdq4sds4sdt4sdu4sdv4sdw4sdz3mek2wel2wem2wen2weo2wep2weq4mer2wes2wet2weu2wev2wew1wex1wey1wez1wfl3mfm3mfn3mfo3mfp3mfq3mfr3sfs3mft3mfu3mfv3mfw3mfz3m203k6o212m6m2dw2l2cq2l3t3m3u1w17s4s19m3m}'kerning'{cl{4qs5ku17sw5ou5qy5rw201ss5tw201ws}201s{201ss}201t{ckw4lwcmwcnwcowcpwclw4wu201ts}2k{201ts}2w{4qs5kw5os5qx5ru17sx5tx}2x{17sw5tw5ou5qu}2y{4qs5kw5os5qx5ru17sx5tx}'fof'-6o7t{ckuclucmucnucoucpu4lu5os5rs}3u{17su5tu5qs}3v{17su5tu5qs}7p{17sw5tw5qs}ck{4qs5ku17sw5ou5qy5rw201ss5tw201ws}4l{4qs5ku17sw5ou5qy5rw201ss5tw201ws}cm{4qs5ku17sw5ou5qy5rw201ss5tw201ws}cn{4qs5ku17sw5ou5qy5rw201ss5tw201ws}co{4qs5ku17sw5ou5qy5rw201ss5tw201ws}cp{4qs5ku17sw5ou5qy5rw201ss5tw201ws}6l{17su5tu5os5qw5rs}17s{2ktclvcmvcnvcovcpv4lv4wuckv}5o{ckwclwcmwcnwcowcpw4lw4wu}5q{ckyclycmycnycoycpy4ly4wu5ms}5r{cktcltcmtcntcotcpt4lt4ws}5t{2ktclvcmvcnvcovcpv4lv4wuckv}7q{cksclscmscnscoscps4ls}6p{17su5tu5qw5rs}ek{5qs5rs}el{17su5tu5os5qw5rs}em{17su5tu5os5qs5rs}en{17su5qs5rs}eo{5qs5rs}ep{17su5tu5os5qw5rs}es{5qs}et{17su5tu5qw5rs}eu{17su5tu5qs5rs}ev{5qs}6z{17sv5tv5os5qx5rs}fm{5os5qt5rs}fn{17sv5tv5os5qx5rs}fo{17sv5tv5os5qx5rs}fp{5os5qt5rs}fq{5os5qt5rs}7r{ckuclucmucnucoucpu4lu5os}fs{17sv5tv5os5qx5rs}ft{17ss5ts5qs}fu{17sw5tw5qs}fv{17sw5tw5qs}fw{17ss5ts5qs}fz{ckuclucmucnucoucpu4lu5os5rs}}}"),"Helvetica-Oblique":a("{'widths'{k3p2q4mcx1w201n3r201o6o201s1q201t1q201u1q201w2l201x2l201y2l2k1w2l1w202m2n2n3r2o3r2p5t202q6o2r1n2s2l2t2l2u2r2v3u2w1w2x2l2y1w2z1w3k3r3l3r3m3r3n3r3o3r3p3r3q3r3r3r3s3r203t2l203u2l3v1w3w3u3x3u3y3u3z3r4k6p4l4m4m4m4n4s4o4s4p4m4q3x4r4y4s4s4t1w4u3m4v4m4w3r4x5n4y4s4z4y5k4m5l4y5m4s5n4m5o3x5p4s5q4m5r5y5s4m5t4m5u3x5v1w5w1w5x1w5y2z5z3r6k2l6l3r6m3r6n3m6o3r6p3r6q1w6r3r6s3r6t1q6u1q6v3m6w1q6x5n6y3r6z3r7k3r7l3r7m2l7n3m7o1w7p3r7q3m7r4s7s3m7t3m7u3m7v2l7w1u7x2l7y3u202l3rcl4mal2lam3ran3rao3rap3rar3ras2lat4tau2pav3raw3uay4taz2lbk2sbl3u'fof'6obo2lbp3rbr1wbs2lbu2obv3rbz3xck4m202k3rcm4mcn4mco4mcp4mcq6ocr4scs4mct4mcu4mcv4mcw1w2m2ncy1wcz1wdl4sdm4ydn4ydo4ydp4ydq4yds4ydt4sdu4sdv4sdw4sdz3xek3rel3rem3ren3reo3rep3req5ter3mes3ret3reu3rev3rew1wex1wey1wez1wfl3rfm3rfn3rfo3rfp3rfq3rfr3ufs3xft3rfu3rfv3rfw3rfz3m203k6o212m6o2dw2l2cq2l3t3r3u1w17s4m19m3r}'kerning'{5q{4wv}cl{4qs5kw5ow5qs17sv5tv}201t{2wu4w1k2yu}201x{2wu4wy2yu}17s{2ktclucmucnu4otcpu4lu4wycoucku}2w{7qs4qz5k1m17sy5ow5qx5rsfsu5ty7tufzu}2x{17sy5ty5oy5qs}2y{7qs4qz5k1m17sy5ow5qx5rsfsu5ty7tufzu}'fof'-6o7p{17sv5tv5ow}ck{4qs5kw5ow5qs17sv5tv}4l{4qs5kw5ow5qs17sv5tv}cm{4qs5kw5ow5qs17sv5tv}cn{4qs5kw5ow5qs17sv5tv}co{4qs5kw5ow5qs17sv5tv}cp{4qs5kw5ow5qs17sv5tv}6l{17sy5ty5ow}do{17st5tt}4z{17st5tt}7s{fst}dm{17st5tt}dn{17st5tt}5o{ckwclwcmwcnwcowcpw4lw4wv}dp{17st5tt}dq{17st5tt}7t{5ow}ds{17st5tt}5t{2ktclucmucnu4otcpu4lu4wycoucku}fu{17sv5tv5ow}6p{17sy5ty5ow5qs}ek{17sy5ty5ow}el{17sy5ty5ow}em{17sy5ty5ow}en{5ty}eo{17sy5ty5ow}ep{17sy5ty5ow}es{17sy5ty5qs}et{17sy5ty5ow5qs}eu{17sy5ty5ow5qs}ev{17sy5ty5ow5qs}6z{17sy5ty5ow5qs}fm{17sy5ty5ow5qs}fn{17sy5ty5ow5qs}fo{17sy5ty5ow5qs}fp{17sy5ty5qs}fq{17sy5ty5ow5qs}7r{5ow}fs{17sy5ty5ow5qs}ft{17sv5tv5ow}7m{5ow}fv{17sv5tv5ow}fw{17sv5tv5ow}}}")}};e.events.push(["addFont",function(e){var t=e.font,r=c.Unicode[t.postScriptName];r&&(t.metadata.Unicode={},t.metadata.Unicode.widths=r.widths,t.metadata.Unicode.kerning=r.kerning);var n=u.Unicode[t.postScriptName];n&&(t.metadata.Unicode.encoding=n,t.encoding=n.codePages[0])}])}(H.API),function(e){var t=function(e){for(var t=e.length,r=new Uint8Array(t),n=0;n<t;n++)r[n]=e.charCodeAt(n);return r};e.API.events.push(["addFont",function(r){var n=void 0,o=r.font,s=r.instance;if(!o.isStandardFont){if(void 0===s)throw new Error("Font does not exist in vFS, import fonts or remove declaration doc.addFont('"+o.postScriptName+"').");if("string"!=typeof(n=!1===s.existsFileInVFS(o.postScriptName)?s.loadFile(o.postScriptName):s.getFileFromVFS(o.postScriptName)))throw new Error("Font is not stored as string-data in vFS, import fonts or remove declaration doc.addFont('"+o.postScriptName+"').");!function(r,n){n=/^\x00\x01\x00\x00/.test(n)?t(n):t(c(n)),r.metadata=e.API.TTFFont.open(n),r.metadata.Unicode=r.metadata.Unicode||{encoding:{},kerning:{},widths:[]},r.metadata.glyIdsUsed=[0]}(o,n)}}])}(H),function(e){function t(){return(o.canvg?Promise.resolve(o.canvg):Promise.resolve().then(r.bind(r,"./node_modules/canvg/lib/index.es.js"))).catch((function(e){return Promise.reject(new Error("Could not load canvg: "+e))})).then((function(e){return e.default?e.default:e}))}H.API.addSvgAsImage=function(e,r,n,o,s,a,A,u){if(isNaN(r)||isNaN(n))throw i.error("jsPDF.addSvgAsImage: Invalid coordinates",arguments),new Error("Invalid coordinates passed to jsPDF.addSvgAsImage");if(isNaN(o)||isNaN(s))throw i.error("jsPDF.addSvgAsImage: Invalid measurements",arguments),new Error("Invalid measurements (width and/or height) passed to jsPDF.addSvgAsImage");var c=document.createElement("canvas");c.width=o,c.height=s;var l=c.getContext("2d");l.fillStyle="#fff",l.fillRect(0,0,c.width,c.height);var d={ignoreMouse:!0,ignoreAnimation:!0,ignoreDimensions:!0},f=this;return t().then((function(t){return t.fromString(l,e,d)}),(function(){return Promise.reject(new Error("Could not load canvg."))})).then((function(e){return e.render(d)})).then((function(){f.addImage(c.toDataURL("image/jpeg",1),r,n,o,s,A,u)}))}}(),H.API.putTotalPages=function(e){var t,r=0;parseInt(this.internal.getFont().id.substr(1),10)<15?(t=new RegExp(e,"g"),r=this.internal.getNumberOfPages()):(t=new RegExp(this.pdfEscape16(e,this.internal.getFont()),"g"),r=this.pdfEscape16(this.internal.getNumberOfPages()+"",this.internal.getFont()));for(var n=1;n<=this.internal.getNumberOfPages();n++)for(var o=0;o<this.internal.pages[n].length;o++)this.internal.pages[n][o]=this.internal.pages[n][o].replace(t,r);return this},H.API.viewerPreferences=function(e,t){var r;e=e||{},t=t||!1;var n,o,s,i={HideToolbar:{defaultValue:!1,value:!1,type:"boolean",explicitSet:!1,valueSet:[!0,!1],pdfVersion:1.3},HideMenubar:{defaultValue:!1,value:!1,type:"boolean",explicitSet:!1,valueSet:[!0,!1],pdfVersion:1.3},HideWindowUI:{defaultValue:!1,value:!1,type:"boolean",explicitSet:!1,valueSet:[!0,!1],pdfVersion:1.3},FitWindow:{defaultValue:!1,value:!1,type:"boolean",explicitSet:!1,valueSet:[!0,!1],pdfVersion:1.3},CenterWindow:{defaultValue:!1,value:!1,type:"boolean",explicitSet:!1,valueSet:[!0,!1],pdfVersion:1.3},DisplayDocTitle:{defaultValue:!1,value:!1,type:"boolean",explicitSet:!1,valueSet:[!0,!1],pdfVersion:1.4},NonFullScreenPageMode:{defaultValue:"UseNone",value:"UseNone",type:"name",explicitSet:!1,valueSet:["UseNone","UseOutlines","UseThumbs","UseOC"],pdfVersion:1.3},Direction:{defaultValue:"L2R",value:"L2R",type:"name",explicitSet:!1,valueSet:["L2R","R2L"],pdfVersion:1.3},ViewArea:{defaultValue:"CropBox",value:"CropBox",type:"name",explicitSet:!1,valueSet:["MediaBox","CropBox","TrimBox","BleedBox","ArtBox"],pdfVersion:1.4},ViewClip:{defaultValue:"CropBox",value:"CropBox",type:"name",explicitSet:!1,valueSet:["MediaBox","CropBox","TrimBox","BleedBox","ArtBox"],pdfVersion:1.4},PrintArea:{defaultValue:"CropBox",value:"CropBox",type:"name",explicitSet:!1,valueSet:["MediaBox","CropBox","TrimBox","BleedBox","ArtBox"],pdfVersion:1.4},PrintClip:{defaultValue:"CropBox",value:"CropBox",type:"name",explicitSet:!1,valueSet:["MediaBox","CropBox","TrimBox","BleedBox","ArtBox"],pdfVersion:1.4},PrintScaling:{defaultValue:"AppDefault",value:"AppDefault",type:"name",explicitSet:!1,valueSet:["AppDefault","None"],pdfVersion:1.6},Duplex:{defaultValue:"",value:"none",type:"name",explicitSet:!1,valueSet:["Simplex","DuplexFlipShortEdge","DuplexFlipLongEdge","none"],pdfVersion:1.7},PickTrayByPDFSize:{defaultValue:!1,value:!1,type:"boolean",explicitSet:!1,valueSet:[!0,!1],pdfVersion:1.7},PrintPageRange:{defaultValue:"",value:"",type:"array",explicitSet:!1,valueSet:null,pdfVersion:1.7},NumCopies:{defaultValue:1,value:1,type:"integer",explicitSet:!1,valueSet:null,pdfVersion:1.7}},a=Object.keys(i),A=[],u=0,c=0,l=0;function d(e,t){var r,n=!1;for(r=0;r<e.length;r+=1)e[r]===t&&(n=!0);return n}if(void 0===this.internal.viewerpreferences&&(this.internal.viewerpreferences={},this.internal.viewerpreferences.configuration=JSON.parse(JSON.stringify(i)),this.internal.viewerpreferences.isSubscribed=!1),r=this.internal.viewerpreferences.configuration,"reset"===e||!0===t){var f=a.length;for(l=0;l<f;l+=1)r[a[l]].value=r[a[l]].defaultValue,r[a[l]].explicitSet=!1}if("object"==typeof e)for(o in e)if(s=e[o],d(a,o)&&void 0!==s){if("boolean"===r[o].type&&"boolean"==typeof s)r[o].value=s;else if("name"===r[o].type&&d(r[o].valueSet,s))r[o].value=s;else if("integer"===r[o].type&&Number.isInteger(s))r[o].value=s;else if("array"===r[o].type){for(u=0;u<s.length;u+=1)if(n=!0,1===s[u].length&&"number"==typeof s[u][0])A.push(String(s[u]-1));else if(s[u].length>1){for(c=0;c<s[u].length;c+=1)"number"!=typeof s[u][c]&&(n=!1);!0===n&&A.push([s[u][0]-1,s[u][1]-1].join(" "))}r[o].value="["+A.join(" ")+"]"}else r[o].value=r[o].defaultValue;r[o].explicitSet=!0}return!1===this.internal.viewerpreferences.isSubscribed&&(this.internal.events.subscribe("putCatalog",(function(){var e,t=[];for(e in r)!0===r[e].explicitSet&&("name"===r[e].type?t.push("/"+e+" /"+r[e].value):t.push("/"+e+" "+r[e].value));0!==t.length&&this.internal.write("/ViewerPreferences\n<<\n"+t.join("\n")+"\n>>")})),this.internal.viewerpreferences.isSubscribed=!0),this.internal.viewerpreferences.configuration=r,this},function(e){var t=function(){var e='<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"><rdf:Description rdf:about="" xmlns:jspdf="'+this.internal.__metadata__.namespaceuri+'"><jspdf:metadata>',t=unescape(encodeURIComponent('<x:xmpmeta xmlns:x="adobe:ns:meta/">')),r=unescape(encodeURIComponent(e)),n=unescape(encodeURIComponent(this.internal.__metadata__.metadata)),o=unescape(encodeURIComponent("</jspdf:metadata></rdf:Description></rdf:RDF>")),s=unescape(encodeURIComponent("</x:xmpmeta>")),i=r.length+n.length+o.length+t.length+s.length;this.internal.__metadata__.metadata_object_number=this.internal.newObject(),this.internal.write("<< /Type /Metadata /Subtype /XML /Length "+i+" >>"),this.internal.write("stream"),this.internal.write(t+r+n+o+s),this.internal.write("endstream"),this.internal.write("endobj")},r=function(){this.internal.__metadata__.metadata_object_number&&this.internal.write("/Metadata "+this.internal.__metadata__.metadata_object_number+" 0 R")};e.addMetadata=function(e,n){return void 0===this.internal.__metadata__&&(this.internal.__metadata__={metadata:e,namespaceuri:n||"http://jspdf.default.namespaceuri/"},this.internal.events.subscribe("putCatalog",r),this.internal.events.subscribe("postPutResources",t)),this}}(H.API),function(e){var t=e.API,r=t.pdfEscape16=function(e,t){for(var r,n=t.metadata.Unicode.widths,o=["","0","00","000","0000"],s=[""],i=0,a=e.length;i<a;++i){if(r=t.metadata.characterToGlyph(e.charCodeAt(i)),t.metadata.glyIdsUsed.push(r),t.metadata.toUnicode[r]=e.charCodeAt(i),-1==n.indexOf(r)&&(n.push(r),n.push([parseInt(t.metadata.widthOfGlyph(r),10)])),"0"==r)return s.join("");r=r.toString(16),s.push(o[4-r.length],r)}return s.join("")},n=function(e){var t,r,n,o,s,i,a;for(s="/CIDInit /ProcSet findresource begin\n12 dict begin\nbegincmap\n/CIDSystemInfo <<\n  /Registry (Adobe)\n  /Ordering (UCS)\n  /Supplement 0\n>> def\n/CMapName /Adobe-Identity-UCS def\n/CMapType 2 def\n1 begincodespacerange\n<0000><ffff>\nendcodespacerange",n=[],i=0,a=(r=Object.keys(e).sort((function(e,t){return e-t}))).length;i<a;i++)t=r[i],n.length>=100&&(s+="\n"+n.length+" beginbfchar\n"+n.join("\n")+"\nendbfchar",n=[]),void 0!==e[t]&&null!==e[t]&&"function"==typeof e[t].toString&&(o=("0000"+e[t].toString(16)).slice(-4),t=("0000"+(+t).toString(16)).slice(-4),n.push("<"+t+"><"+o+">"));return n.length&&(s+="\n"+n.length+" beginbfchar\n"+n.join("\n")+"\nendbfchar\n"),s+"endcmap\nCMapName currentdict /CMap defineresource pop\nend\nend"};t.events.push(["putFont",function(t){!function(t){var r=t.font,o=t.out,s=t.newObject,i=t.putStream,a=t.pdfEscapeWithNeededParanthesis;if(r.metadata instanceof e.API.TTFFont&&"Identity-H"===r.encoding){for(var A=r.metadata.Unicode.widths,u=r.metadata.subset.encode(r.metadata.glyIdsUsed,1),c="",l=0;l<u.length;l++)c+=String.fromCharCode(u[l]);var d=s();i({data:c,addLength1:!0,objectId:d}),o("endobj");var f=s();i({data:n(r.metadata.toUnicode),addLength1:!0,objectId:f}),o("endobj");var h=s();o("<<"),o("/Type /FontDescriptor"),o("/FontName /"+a(r.fontName)),o("/FontFile2 "+d+" 0 R"),o("/FontBBox "+e.API.PDFObject.convert(r.metadata.bbox)),o("/Flags "+r.metadata.flags),o("/StemV "+r.metadata.stemV),o("/ItalicAngle "+r.metadata.italicAngle),o("/Ascent "+r.metadata.ascender),o("/Descent "+r.metadata.decender),o("/CapHeight "+r.metadata.capHeight),o(">>"),o("endobj");var p=s();o("<<"),o("/Type /Font"),o("/BaseFont /"+a(r.fontName)),o("/FontDescriptor "+h+" 0 R"),o("/W "+e.API.PDFObject.convert(A)),o("/CIDToGIDMap /Identity"),o("/DW 1000"),o("/Subtype /CIDFontType2"),o("/CIDSystemInfo"),o("<<"),o("/Supplement 0"),o("/Registry (Adobe)"),o("/Ordering ("+r.encoding+")"),o(">>"),o(">>"),o("endobj"),r.objectNumber=s(),o("<<"),o("/Type /Font"),o("/Subtype /Type0"),o("/ToUnicode "+f+" 0 R"),o("/BaseFont /"+a(r.fontName)),o("/Encoding /"+r.encoding),o("/DescendantFonts ["+p+" 0 R]"),o(">>"),o("endobj"),r.isAlreadyPutted=!0}}(t)}]),t.events.push(["putFont",function(t){!function(t){var r=t.font,o=t.out,s=t.newObject,i=t.putStream,a=t.pdfEscapeWithNeededParanthesis;if(r.metadata instanceof e.API.TTFFont&&"WinAnsiEncoding"===r.encoding){for(var A=r.metadata.rawData,u="",c=0;c<A.length;c++)u+=String.fromCharCode(A[c]);var l=s();i({data:u,addLength1:!0,objectId:l}),o("endobj");var d=s();i({data:n(r.metadata.toUnicode),addLength1:!0,objectId:d}),o("endobj");var f=s();o("<<"),o("/Descent "+r.metadata.decender),o("/CapHeight "+r.metadata.capHeight),o("/StemV "+r.metadata.stemV),o("/Type /FontDescriptor"),o("/FontFile2 "+l+" 0 R"),o("/Flags 96"),o("/FontBBox "+e.API.PDFObject.convert(r.metadata.bbox)),o("/FontName /"+a(r.fontName)),o("/ItalicAngle "+r.metadata.italicAngle),o("/Ascent "+r.metadata.ascender),o(">>"),o("endobj"),r.objectNumber=s();for(var h=0;h<r.metadata.hmtx.widths.length;h++)r.metadata.hmtx.widths[h]=parseInt(r.metadata.hmtx.widths[h]*(1e3/r.metadata.head.unitsPerEm));o("<</Subtype/TrueType/Type/Font/ToUnicode "+d+" 0 R/BaseFont/"+a(r.fontName)+"/FontDescriptor "+f+" 0 R/Encoding/"+r.encoding+" /FirstChar 29 /LastChar 255 /Widths "+e.API.PDFObject.convert(r.metadata.hmtx.widths)+">>"),o("endobj"),r.isAlreadyPutted=!0}}(t)}]);var o=function(e){var t,n=e.text||"",o=e.x,s=e.y,i=e.options||{},a=e.mutex||{},A=a.pdfEscape,u=a.activeFontKey,c=a.fonts,l=u,d="",f=0,h="",p=c[l].encoding;if("Identity-H"!==c[l].encoding)return{text:n,x:o,y:s,options:i,mutex:a};for(h=n,l=u,Array.isArray(n)&&(h=n[0]),f=0;f<h.length;f+=1)c[l].metadata.hasOwnProperty("cmap")&&(t=c[l].metadata.cmap.unicode.codeMap[h[f].charCodeAt(0)]),t||h[f].charCodeAt(0)<256&&c[l].metadata.hasOwnProperty("Unicode")?d+=h[f]:d+="";var m="";return parseInt(l.slice(1))<14||"WinAnsiEncoding"===p?m=A(d,l).split("").map((function(e){return e.charCodeAt(0).toString(16)})).join(""):"Identity-H"===p&&(m=r(d,c[l])),a.isHex=!0,{text:m,x:o,y:s,options:i,mutex:a}};t.events.push(["postProcessText",function(e){var t=e.text||"",r=[],n={text:t,x:e.x,y:e.y,options:e.options,mutex:e.mutex};if(Array.isArray(t)){var s=0;for(s=0;s<t.length;s+=1)Array.isArray(t[s])&&3===t[s].length?r.push([o(Object.assign({},n,{text:t[s][0]})).text,t[s][1],t[s][2]]):r.push(o(Object.assign({},n,{text:t[s]})).text);e.text=r}else e.text=o(Object.assign({},n,{text:t})).text}])}(H),function(e){var t=function(){return void 0===this.internal.vFS&&(this.internal.vFS={}),!0};e.existsFileInVFS=function(e){return t.call(this),void 0!==this.internal.vFS[e]},e.addFileToVFS=function(e,r){return t.call(this),this.internal.vFS[e]=r,this},e.getFileFromVFS=function(e){return t.call(this),void 0!==this.internal.vFS[e]?this.internal.vFS[e]:null}}(H.API),function(e){e.__bidiEngine__=e.prototype.__bidiEngine__=function(e){var r,n,o,s,i,a,A,u=t,c=[[0,3,0,1,0,0,0],[0,3,0,1,2,2,0],[0,3,0,17,2,0,1],[0,3,5,5,4,1,0],[0,3,21,21,4,0,1],[0,3,5,5,4,2,0]],l=[[2,0,1,1,0,1,0],[2,0,1,1,0,2,0],[2,0,2,1,3,2,0],[2,0,2,33,3,1,1]],d={L:0,R:1,EN:2,AN:3,N:4,B:5,S:6},f={0:0,5:1,6:2,7:3,32:4,251:5,254:6,255:7},h=["(",")","(","<",">","<","[","]","[","{","}","{","«","»","«","‹","›","‹","⁅","⁆","⁅","⁽","⁾","⁽","₍","₎","₍","≤","≥","≤","〈","〉","〈","﹙","﹚","﹙","﹛","﹜","﹛","﹝","﹞","﹝","﹤","﹥","﹤"],p=new RegExp(/^([1-4|9]|1[0-9]|2[0-9]|3[0168]|4[04589]|5[012]|7[78]|159|16[0-9]|17[0-2]|21[569]|22[03489]|250)$/),m=!1,g=0;this.__bidiEngine__={};var y=function(e){var t=e.charCodeAt(),r=t>>8,n=f[r];return void 0!==n?u[256*n+(255&t)]:252===r||253===r?"AL":p.test(r)?"L":8===r?"R":"N"},v=function(e){for(var t,r=0;r<e.length;r++){if("L"===(t=y(e.charAt(r))))return!1;if("R"===t)return!0}return!1},w=function(e,t,i,a){var A,u,c,l,d=t[a];switch(d){case"L":case"R":m=!1;break;case"N":case"AN":break;case"EN":m&&(d="AN");break;case"AL":m=!0,d="R";break;case"WS":d="N";break;case"CS":a<1||a+1>=t.length||"EN"!==(A=i[a-1])&&"AN"!==A||"EN"!==(u=t[a+1])&&"AN"!==u?d="N":m&&(u="AN"),d=u===A?u:"N";break;case"ES":d="EN"===(A=a>0?i[a-1]:"B")&&a+1<t.length&&"EN"===t[a+1]?"EN":"N";break;case"ET":if(a>0&&"EN"===i[a-1]){d="EN";break}if(m){d="N";break}for(c=a+1,l=t.length;c<l&&"ET"===t[c];)c++;d=c<l&&"EN"===t[c]?"EN":"N";break;case"NSM":if(o&&!s){for(l=t.length,c=a+1;c<l&&"NSM"===t[c];)c++;if(c<l){var f=e[a],h=f>=1425&&f<=2303||64286===f;if(A=t[c],h&&("R"===A||"AL"===A)){d="R";break}}}d=a<1||"B"===(A=t[a-1])?"N":i[a-1];break;case"B":m=!1,r=!0,d=g;break;case"S":n=!0,d="N";break;case"LRE":case"RLE":case"LRO":case"RLO":case"PDF":m=!1;break;case"BN":d="N"}return d},b=function(e,t,r){var n=e.split("");return r&&B(n,r,{hiLevel:g}),n.reverse(),t&&t.reverse(),n.join("")},B=function(e,t,o){var s,i,a,A,u,f=-1,h=e.length,p=0,v=[],b=g?l:c,B=[];for(m=!1,r=!1,n=!1,i=0;i<h;i++)B[i]=y(e[i]);for(a=0;a<h;a++){if(u=p,v[a]=w(e,B,v,a),s=240&(p=b[u][d[v[a]]]),p&=15,t[a]=A=b[p][5],s>0)if(16===s){for(i=f;i<a;i++)t[i]=1;f=-1}else f=-1;if(b[p][6])-1===f&&(f=a);else if(f>-1){for(i=f;i<a;i++)t[i]=A;f=-1}"B"===B[a]&&(t[a]=0),o.hiLevel|=A}n&&function(e,t,r){for(var n=0;n<r;n++)if("S"===e[n]){t[n]=g;for(var o=n-1;o>=0&&"WS"===e[o];o--)t[o]=g}}(B,t,h)},j=function(e,t,n,o,s){if(!(s.hiLevel<e)){if(1===e&&1===g&&!r)return t.reverse(),void(n&&n.reverse());for(var i,a,A,u,c=t.length,l=0;l<c;){if(o[l]>=e){for(A=l+1;A<c&&o[A]>=e;)A++;for(u=l,a=A-1;u<a;u++,a--)i=t[u],t[u]=t[a],t[a]=i,n&&(i=n[u],n[u]=n[a],n[a]=i);l=A}l++}}},_=function(e,t,r){var n=e.split(""),o={hiLevel:g};return r||(r=[]),B(n,r,o),function(e,t,r){if(0!==r.hiLevel&&A)for(var n,o=0;o<e.length;o++)1===t[o]&&(n=h.indexOf(e[o]))>=0&&(e[o]=h[n+1])}(n,r,o),j(2,n,t,r,o),j(1,n,t,r,o),n.join("")};return this.__bidiEngine__.doBidiReorder=function(e,t,r){if(function(e,t){if(t)for(var r=0;r<e.length;r++)t[r]=r;void 0===s&&(s=v(e)),void 0===a&&(a=v(e))}(e,t),o||!i||a)if(o&&i&&s^a)g=s?1:0,e=b(e,t,r);else if(!o&&i&&a)g=s?1:0,e=_(e,t,r),e=b(e,t);else if(!o||s||i||a){if(o&&!i&&s^a)e=b(e,t),s?(g=0,e=_(e,t,r)):(g=1,e=_(e,t,r),e=b(e,t));else if(o&&s&&!i&&a)g=1,e=_(e,t,r),e=b(e,t);else if(!o&&!i&&s^a){var n=A;s?(g=1,e=_(e,t,r),g=0,A=!1,e=_(e,t,r),A=n):(g=0,e=_(e,t,r),e=b(e,t),g=1,A=!1,e=_(e,t,r),A=n,e=b(e,t))}}else g=0,e=_(e,t,r);else g=s?1:0,e=_(e,t,r);return e},this.__bidiEngine__.setOptions=function(e){e&&(o=e.isInputVisual,i=e.isOutputVisual,s=e.isInputRtl,a=e.isOutputRtl,A=e.isSymmetricSwapping)},this.__bidiEngine__.setOptions(e),this.__bidiEngine__};var t=["BN","BN","BN","BN","BN","BN","BN","BN","BN","S","B","S","WS","B","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","B","B","B","S","WS","N","N","ET","ET","ET","N","N","N","N","N","ES","CS","ES","CS","CS","EN","EN","EN","EN","EN","EN","EN","EN","EN","EN","CS","N","N","N","N","N","N","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","N","N","N","N","N","N","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","N","N","N","N","BN","BN","BN","BN","BN","BN","B","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","BN","CS","N","ET","ET","ET","ET","N","N","N","N","L","N","N","BN","N","N","ET","ET","EN","EN","N","L","N","N","N","EN","L","N","N","N","N","N","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","N","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","N","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","N","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","N","N","L","L","L","L","L","L","L","N","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","N","L","N","N","N","N","N","ET","N","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","R","NSM","R","NSM","NSM","R","NSM","NSM","R","NSM","N","N","N","N","N","N","N","N","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","N","N","N","N","N","R","R","R","R","R","N","N","N","N","N","N","N","N","N","N","N","AN","AN","AN","AN","AN","AN","N","N","AL","ET","ET","AL","CS","AL","N","N","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","AL","AL","N","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","AN","AN","AN","AN","AN","AN","AN","AN","AN","AN","ET","AN","AN","AL","AL","AL","NSM","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","NSM","NSM","NSM","NSM","NSM","NSM","NSM","AN","N","NSM","NSM","NSM","NSM","NSM","NSM","AL","AL","NSM","NSM","N","NSM","NSM","NSM","NSM","AL","AL","EN","EN","EN","EN","EN","EN","EN","EN","EN","EN","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","N","AL","AL","NSM","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","N","N","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","AL","N","N","N","N","N","N","N","N","N","N","N","N","N","N","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","R","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","R","R","N","N","N","N","R","N","N","N","N","N","WS","WS","WS","WS","WS","WS","WS","WS","WS","WS","WS","BN","BN","BN","L","R","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","WS","B","LRE","RLE","PDF","LRO","RLO","CS","ET","ET","ET","ET","ET","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","CS","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","WS","BN","BN","BN","BN","BN","N","LRI","RLI","FSI","PDI","BN","BN","BN","BN","BN","BN","EN","L","N","N","EN","EN","EN","EN","EN","EN","ES","ES","N","N","N","L","EN","EN","EN","EN","EN","EN","EN","EN","EN","EN","ES","ES","N","N","N","N","L","L","L","L","L","L","L","L","L","L","L","L","L","N","N","N","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","ET","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","L","L","L","L","L","L","L","N","N","N","N","N","N","N","N","N","N","N","N","L","L","L","L","L","N","N","N","N","N","R","NSM","R","R","R","R","R","R","R","R","R","R","ES","R","R","R","R","R","R","R","R","R","R","R","R","R","N","R","R","R","R","R","N","R","N","R","R","N","R","R","N","R","R","R","R","R","R","R","R","R","R","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","NSM","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","CS","N","CS","N","N","CS","N","N","N","N","N","N","N","N","N","ET","N","N","ES","ES","N","N","N","N","N","ET","ET","N","N","N","N","N","AL","AL","AL","AL","AL","N","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","AL","N","N","BN","N","N","N","ET","ET","ET","N","N","N","N","N","ES","CS","ES","CS","CS","EN","EN","EN","EN","EN","EN","EN","EN","EN","EN","CS","N","N","N","N","N","N","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","N","N","N","N","N","N","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","N","N","N","N","N","N","N","N","N","N","N","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","L","N","N","N","L","L","L","L","L","L","N","N","L","L","L","L","L","L","N","N","L","L","L","L","L","L","N","N","L","L","L","N","N","N","ET","ET","N","N","N","ET","ET","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N","N"],r=new e.__bidiEngine__({isInputVisual:!0});e.API.events.push(["postProcessText",function(e){var t=e.text,n=(e.x,e.y,e.options||{}),o=(e.mutex,n.lang,[]);if(n.isInputVisual="boolean"!=typeof n.isInputVisual||n.isInputVisual,r.setOptions(n),"[object Array]"===Object.prototype.toString.call(t)){var s=0;for(o=[],s=0;s<t.length;s+=1)"[object Array]"===Object.prototype.toString.call(t[s])?o.push([r.doBidiReorder(t[s][0]),t[s][1],t[s][2]]):o.push([r.doBidiReorder(t[s])]);e.text=o}else e.text=r.doBidiReorder(t);r.setOptions({isInputVisual:!0})}])}(H),H.API.TTFFont=function(){function e(e){var t;if(this.rawData=e,t=this.contents=new tt(e),this.contents.pos=4,"ttcf"===t.readString(4))throw new Error("TTCF not supported.");t.pos=0,this.parse(),this.subset=new wt(this),this.registerTTF()}return e.open=function(t){return new e(t)},e.prototype.parse=function(){return this.directory=new rt(this.contents),this.head=new st(this),this.name=new dt(this),this.cmap=new at(this),this.toUnicode={},this.hhea=new At(this),this.maxp=new ft(this),this.hmtx=new ht(this),this.post=new ct(this),this.os2=new ut(this),this.loca=new vt(this),this.glyf=new mt(this),this.ascender=this.os2.exists&&this.os2.ascender||this.hhea.ascender,this.decender=this.os2.exists&&this.os2.decender||this.hhea.decender,this.lineGap=this.os2.exists&&this.os2.lineGap||this.hhea.lineGap,this.bbox=[this.head.xMin,this.head.yMin,this.head.xMax,this.head.yMax]},e.prototype.registerTTF=function(){var e,t,r,n,o;if(this.scaleFactor=1e3/this.head.unitsPerEm,this.bbox=function(){var t,r,n,o;for(o=[],t=0,r=(n=this.bbox).length;t<r;t++)e=n[t],o.push(Math.round(e*this.scaleFactor));return o}.call(this),this.stemV=0,this.post.exists?(r=255&(n=this.post.italic_angle),0!=(32768&(t=n>>16))&&(t=-(1+(65535^t))),this.italicAngle=+(t+"."+r)):this.italicAngle=0,this.ascender=Math.round(this.ascender*this.scaleFactor),this.decender=Math.round(this.decender*this.scaleFactor),this.lineGap=Math.round(this.lineGap*this.scaleFactor),this.capHeight=this.os2.exists&&this.os2.capHeight||this.ascender,this.xHeight=this.os2.exists&&this.os2.xHeight||0,this.familyClass=(this.os2.exists&&this.os2.familyClass||0)>>8,this.isSerif=1===(o=this.familyClass)||2===o||3===o||4===o||5===o||7===o,this.isScript=10===this.familyClass,this.flags=0,this.post.isFixedPitch&&(this.flags|=1),this.isSerif&&(this.flags|=2),this.isScript&&(this.flags|=8),0!==this.italicAngle&&(this.flags|=64),this.flags|=32,!this.cmap.unicode)throw new Error("No unicode cmap for font")},e.prototype.characterToGlyph=function(e){var t;return(null!=(t=this.cmap.unicode)?t.codeMap[e]:void 0)||0},e.prototype.widthOfGlyph=function(e){var t;return t=1e3/this.head.unitsPerEm,this.hmtx.forGlyph(e).advance*t},e.prototype.widthOfString=function(e,t,r){var n,o,s,i;for(s=0,o=0,i=(e=""+e).length;0<=i?o<i:o>i;o=0<=i?++o:--o)n=e.charCodeAt(o),s+=this.widthOfGlyph(this.characterToGlyph(n))+r*(1e3/t)||0;return s*(t/1e3)},e.prototype.lineHeight=function(e,t){var r;return null==t&&(t=!1),r=t?this.lineGap:0,(this.ascender+r-this.decender)/1e3*e},e}();var et,tt=function(){function e(e){this.data=null!=e?e:[],this.pos=0,this.length=this.data.length}return e.prototype.readByte=function(){return this.data[this.pos++]},e.prototype.writeByte=function(e){return this.data[this.pos++]=e},e.prototype.readUInt32=function(){return 16777216*this.readByte()+(this.readByte()<<16)+(this.readByte()<<8)+this.readByte()},e.prototype.writeUInt32=function(e){return this.writeByte(e>>>24&255),this.writeByte(e>>16&255),this.writeByte(e>>8&255),this.writeByte(255&e)},e.prototype.readInt32=function(){var e;return(e=this.readUInt32())>=2147483648?e-4294967296:e},e.prototype.writeInt32=function(e){return e<0&&(e+=4294967296),this.writeUInt32(e)},e.prototype.readUInt16=function(){return this.readByte()<<8|this.readByte()},e.prototype.writeUInt16=function(e){return this.writeByte(e>>8&255),this.writeByte(255&e)},e.prototype.readInt16=function(){var e;return(e=this.readUInt16())>=32768?e-65536:e},e.prototype.writeInt16=function(e){return e<0&&(e+=65536),this.writeUInt16(e)},e.prototype.readString=function(e){var t,r;for(r=[],t=0;0<=e?t<e:t>e;t=0<=e?++t:--t)r[t]=String.fromCharCode(this.readByte());return r.join("")},e.prototype.writeString=function(e){var t,r,n;for(n=[],t=0,r=e.length;0<=r?t<r:t>r;t=0<=r?++t:--t)n.push(this.writeByte(e.charCodeAt(t)));return n},e.prototype.readShort=function(){return this.readInt16()},e.prototype.writeShort=function(e){return this.writeInt16(e)},e.prototype.readLongLong=function(){var e,t,r,n,o,s,i,a;return e=this.readByte(),t=this.readByte(),r=this.readByte(),n=this.readByte(),o=this.readByte(),s=this.readByte(),i=this.readByte(),a=this.readByte(),128&e?-1*(72057594037927940*(255^e)+281474976710656*(255^t)+1099511627776*(255^r)+4294967296*(255^n)+16777216*(255^o)+65536*(255^s)+256*(255^i)+(255^a)+1):72057594037927940*e+281474976710656*t+1099511627776*r+4294967296*n+16777216*o+65536*s+256*i+a},e.prototype.writeLongLong=function(e){var t,r;return t=Math.floor(e/4294967296),r=4294967295&e,this.writeByte(t>>24&255),this.writeByte(t>>16&255),this.writeByte(t>>8&255),this.writeByte(255&t),this.writeByte(r>>24&255),this.writeByte(r>>16&255),this.writeByte(r>>8&255),this.writeByte(255&r)},e.prototype.readInt=function(){return this.readInt32()},e.prototype.writeInt=function(e){return this.writeInt32(e)},e.prototype.read=function(e){var t,r;for(t=[],r=0;0<=e?r<e:r>e;r=0<=e?++r:--r)t.push(this.readByte());return t},e.prototype.write=function(e){var t,r,n,o;for(o=[],r=0,n=e.length;r<n;r++)t=e[r],o.push(this.writeByte(t));return o},e}(),rt=function(){var e;function t(e){var t,r,n;for(this.scalarType=e.readInt(),this.tableCount=e.readShort(),this.searchRange=e.readShort(),this.entrySelector=e.readShort(),this.rangeShift=e.readShort(),this.tables={},r=0,n=this.tableCount;0<=n?r<n:r>n;r=0<=n?++r:--r)t={tag:e.readString(4),checksum:e.readInt(),offset:e.readInt(),length:e.readInt()},this.tables[t.tag]=t}return t.prototype.encode=function(t){var r,n,o,s,i,a,A,u,c,l,d,f,h;for(h in d=Object.keys(t).length,a=Math.log(2),c=16*Math.floor(Math.log(d)/a),s=Math.floor(c/a),u=16*d-c,(n=new tt).writeInt(this.scalarType),n.writeShort(d),n.writeShort(c),n.writeShort(s),n.writeShort(u),o=16*d,A=n.pos+o,i=null,f=[],t)for(l=t[h],n.writeString(h),n.writeInt(e(l)),n.writeInt(A),n.writeInt(l.length),f=f.concat(l),"head"===h&&(i=A),A+=l.length;A%4;)f.push(0),A++;return n.write(f),r=2981146554-e(n.data),n.pos=i+8,n.writeUInt32(r),n.data},e=function(e){var t,r,n,o;for(e=pt.call(e);e.length%4;)e.push(0);for(n=new tt(e),r=0,t=0,o=e.length;t<o;t=t+=4)r+=n.readUInt32();return 4294967295&r},t}(),nt={}.hasOwnProperty,ot=function(e,t){for(var r in t)nt.call(t,r)&&(e[r]=t[r]);function n(){this.constructor=e}return n.prototype=t.prototype,e.prototype=new n,e.__super__=t.prototype,e};et=function(){function e(e){var t;this.file=e,t=this.file.directory.tables[this.tag],this.exists=!!t,t&&(this.offset=t.offset,this.length=t.length,this.parse(this.file.contents))}return e.prototype.parse=function(){},e.prototype.encode=function(){},e.prototype.raw=function(){return this.exists?(this.file.contents.pos=this.offset,this.file.contents.read(this.length)):null},e}();var st=function(e){function t(){return t.__super__.constructor.apply(this,arguments)}return ot(t,et),t.prototype.tag="head",t.prototype.parse=function(e){return e.pos=this.offset,this.version=e.readInt(),this.revision=e.readInt(),this.checkSumAdjustment=e.readInt(),this.magicNumber=e.readInt(),this.flags=e.readShort(),this.unitsPerEm=e.readShort(),this.created=e.readLongLong(),this.modified=e.readLongLong(),this.xMin=e.readShort(),this.yMin=e.readShort(),this.xMax=e.readShort(),this.yMax=e.readShort(),this.macStyle=e.readShort(),this.lowestRecPPEM=e.readShort(),this.fontDirectionHint=e.readShort(),this.indexToLocFormat=e.readShort(),this.glyphDataFormat=e.readShort()},t.prototype.encode=function(e){var t;return(t=new tt).writeInt(this.version),t.writeInt(this.revision),t.writeInt(this.checkSumAdjustment),t.writeInt(this.magicNumber),t.writeShort(this.flags),t.writeShort(this.unitsPerEm),t.writeLongLong(this.created),t.writeLongLong(this.modified),t.writeShort(this.xMin),t.writeShort(this.yMin),t.writeShort(this.xMax),t.writeShort(this.yMax),t.writeShort(this.macStyle),t.writeShort(this.lowestRecPPEM),t.writeShort(this.fontDirectionHint),t.writeShort(e),t.writeShort(this.glyphDataFormat),t.data},t}(),it=function(){function e(e,t){var r,n,o,s,i,a,A,u,c,l,d,f,h,p,m,g,y;switch(this.platformID=e.readUInt16(),this.encodingID=e.readShort(),this.offset=t+e.readInt(),c=e.pos,e.pos=this.offset,this.format=e.readUInt16(),this.length=e.readUInt16(),this.language=e.readUInt16(),this.isUnicode=3===this.platformID&&1===this.encodingID&&4===this.format||0===this.platformID&&4===this.format,this.codeMap={},this.format){case 0:for(a=0;a<256;++a)this.codeMap[a]=e.readByte();break;case 4:for(d=e.readUInt16(),l=d/2,e.pos+=6,o=function(){var t,r;for(r=[],a=t=0;0<=l?t<l:t>l;a=0<=l?++t:--t)r.push(e.readUInt16());return r}(),e.pos+=2,h=function(){var t,r;for(r=[],a=t=0;0<=l?t<l:t>l;a=0<=l?++t:--t)r.push(e.readUInt16());return r}(),A=function(){var t,r;for(r=[],a=t=0;0<=l?t<l:t>l;a=0<=l?++t:--t)r.push(e.readUInt16());return r}(),u=function(){var t,r;for(r=[],a=t=0;0<=l?t<l:t>l;a=0<=l?++t:--t)r.push(e.readUInt16());return r}(),n=(this.length-e.pos+this.offset)/2,i=function(){var t,r;for(r=[],a=t=0;0<=n?t<n:t>n;a=0<=n?++t:--t)r.push(e.readUInt16());return r}(),a=m=0,y=o.length;m<y;a=++m)for(p=o[a],r=g=f=h[a];f<=p?g<=p:g>=p;r=f<=p?++g:--g)0===u[a]?s=r+A[a]:0!==(s=i[u[a]/2+(r-f)-(l-a)]||0)&&(s+=A[a]),this.codeMap[r]=65535&s}e.pos=c}return e.encode=function(e,t){var r,n,o,s,i,a,A,u,c,l,d,f,h,p,m,g,y,v,w,b,B,j,_,C,x,E,N,Q,F,U,S,L,T,H,I,P,O,k,R,M,D,K,z,V,q,G;switch(Q=new tt,s=Object.keys(e).sort((function(e,t){return e-t})),t){case"macroman":for(h=0,p=function(){var e=[];for(f=0;f<256;++f)e.push(0);return e}(),g={0:0},o={},F=0,T=s.length;F<T;F++)null==g[z=e[n=s[F]]]&&(g[z]=++h),o[n]={old:e[n],new:g[e[n]]},p[n]=g[e[n]];return Q.writeUInt16(1),Q.writeUInt16(0),Q.writeUInt32(12),Q.writeUInt16(0),Q.writeUInt16(262),Q.writeUInt16(0),Q.write(p),{charMap:o,subtable:Q.data,maxGlyphID:h+1};case"unicode":for(E=[],c=[],y=0,g={},r={},m=A=null,U=0,H=s.length;U<H;U++)null==g[w=e[n=s[U]]]&&(g[w]=++y),r[n]={old:w,new:g[w]},i=g[w]-n,null!=m&&i===A||(m&&c.push(m),E.push(n),A=i),m=n;for(m&&c.push(m),c.push(65535),E.push(65535),C=2*(_=E.length),j=2*Math.pow(Math.log(_)/Math.LN2,2),l=Math.log(j/2)/Math.LN2,B=2*_-j,a=[],b=[],d=[],f=S=0,I=E.length;S<I;f=++S){if(x=E[f],u=c[f],65535===x){a.push(0),b.push(0);break}if(x-(N=r[x].new)>=32768)for(a.push(0),b.push(2*(d.length+_-f)),n=L=x;x<=u?L<=u:L>=u;n=x<=u?++L:--L)d.push(r[n].new);else a.push(N-x),b.push(0)}for(Q.writeUInt16(3),Q.writeUInt16(1),Q.writeUInt32(12),Q.writeUInt16(4),Q.writeUInt16(16+8*_+2*d.length),Q.writeUInt16(0),Q.writeUInt16(C),Q.writeUInt16(j),Q.writeUInt16(l),Q.writeUInt16(B),D=0,P=c.length;D<P;D++)n=c[D],Q.writeUInt16(n);for(Q.writeUInt16(0),K=0,O=E.length;K<O;K++)n=E[K],Q.writeUInt16(n);for(V=0,k=a.length;V<k;V++)i=a[V],Q.writeUInt16(i);for(q=0,R=b.length;q<R;q++)v=b[q],Q.writeUInt16(v);for(G=0,M=d.length;G<M;G++)h=d[G],Q.writeUInt16(h);return{charMap:r,subtable:Q.data,maxGlyphID:y+1}}},e}(),at=function(e){function t(){return t.__super__.constructor.apply(this,arguments)}return ot(t,et),t.prototype.tag="cmap",t.prototype.parse=function(e){var t,r,n;for(e.pos=this.offset,this.version=e.readUInt16(),n=e.readUInt16(),this.tables=[],this.unicode=null,r=0;0<=n?r<n:r>n;r=0<=n?++r:--r)t=new it(e,this.offset),this.tables.push(t),t.isUnicode&&null==this.unicode&&(this.unicode=t);return!0},t.encode=function(e,t){var r,n;return null==t&&(t="macroman"),r=it.encode(e,t),(n=new tt).writeUInt16(0),n.writeUInt16(1),r.table=n.data.concat(r.subtable),r},t}(),At=function(e){function t(){return t.__super__.constructor.apply(this,arguments)}return ot(t,et),t.prototype.tag="hhea",t.prototype.parse=function(e){return e.pos=this.offset,this.version=e.readInt(),this.ascender=e.readShort(),this.decender=e.readShort(),this.lineGap=e.readShort(),this.advanceWidthMax=e.readShort(),this.minLeftSideBearing=e.readShort(),this.minRightSideBearing=e.readShort(),this.xMaxExtent=e.readShort(),this.caretSlopeRise=e.readShort(),this.caretSlopeRun=e.readShort(),this.caretOffset=e.readShort(),e.pos+=8,this.metricDataFormat=e.readShort(),this.numberOfMetrics=e.readUInt16()},t}(),ut=function(e){function t(){return t.__super__.constructor.apply(this,arguments)}return ot(t,et),t.prototype.tag="OS/2",t.prototype.parse=function(e){if(e.pos=this.offset,this.version=e.readUInt16(),this.averageCharWidth=e.readShort(),this.weightClass=e.readUInt16(),this.widthClass=e.readUInt16(),this.type=e.readShort(),this.ySubscriptXSize=e.readShort(),this.ySubscriptYSize=e.readShort(),this.ySubscriptXOffset=e.readShort(),this.ySubscriptYOffset=e.readShort(),this.ySuperscriptXSize=e.readShort(),this.ySuperscriptYSize=e.readShort(),this.ySuperscriptXOffset=e.readShort(),this.ySuperscriptYOffset=e.readShort(),this.yStrikeoutSize=e.readShort(),this.yStrikeoutPosition=e.readShort(),this.familyClass=e.readShort(),this.panose=function(){var t,r;for(r=[],t=0;t<10;++t)r.push(e.readByte());return r}(),this.charRange=function(){var t,r;for(r=[],t=0;t<4;++t)r.push(e.readInt());return r}(),this.vendorID=e.readString(4),this.selection=e.readShort(),this.firstCharIndex=e.readShort(),this.lastCharIndex=e.readShort(),this.version>0&&(this.ascent=e.readShort(),this.descent=e.readShort(),this.lineGap=e.readShort(),this.winAscent=e.readShort(),this.winDescent=e.readShort(),this.codePageRange=function(){var t,r;for(r=[],t=0;t<2;t=++t)r.push(e.readInt());return r}(),this.version>1))return this.xHeight=e.readShort(),this.capHeight=e.readShort(),this.defaultChar=e.readShort(),this.breakChar=e.readShort(),this.maxContext=e.readShort()},t}(),ct=function(e){function t(){return t.__super__.constructor.apply(this,arguments)}return ot(t,et),t.prototype.tag="post",t.prototype.parse=function(e){var t,r,n;switch(e.pos=this.offset,this.format=e.readInt(),this.italicAngle=e.readInt(),this.underlinePosition=e.readShort(),this.underlineThickness=e.readShort(),this.isFixedPitch=e.readInt(),this.minMemType42=e.readInt(),this.maxMemType42=e.readInt(),this.minMemType1=e.readInt(),this.maxMemType1=e.readInt(),this.format){case 65536:break;case 131072:var o;for(r=e.readUInt16(),this.glyphNameIndex=[],o=0;0<=r?o<r:o>r;o=0<=r?++o:--o)this.glyphNameIndex.push(e.readUInt16());for(this.names=[],n=[];e.pos<this.offset+this.length;)t=e.readByte(),n.push(this.names.push(e.readString(t)));return n;case 151552:return r=e.readUInt16(),this.offsets=e.read(r);case 196608:break;case 262144:return this.map=function(){var t,r,n;for(n=[],o=t=0,r=this.file.maxp.numGlyphs;0<=r?t<r:t>r;o=0<=r?++t:--t)n.push(e.readUInt32());return n}.call(this)}},t}(),lt=function(e,t){this.raw=e,this.length=e.length,this.platformID=t.platformID,this.encodingID=t.encodingID,this.languageID=t.languageID},dt=function(e){function t(){return t.__super__.constructor.apply(this,arguments)}return ot(t,et),t.prototype.tag="name",t.prototype.parse=function(e){var t,r,n,o,s,i,a,A,u,c,l;for(e.pos=this.offset,e.readShort(),t=e.readShort(),i=e.readShort(),r=[],o=0;0<=t?o<t:o>t;o=0<=t?++o:--o)r.push({platformID:e.readShort(),encodingID:e.readShort(),languageID:e.readShort(),nameID:e.readShort(),length:e.readShort(),offset:this.offset+i+e.readShort()});for(a={},o=u=0,c=r.length;u<c;o=++u)n=r[o],e.pos=n.offset,A=e.readString(n.length),s=new lt(A,n),null==a[l=n.nameID]&&(a[l]=[]),a[n.nameID].push(s);this.strings=a,this.copyright=a[0],this.fontFamily=a[1],this.fontSubfamily=a[2],this.uniqueSubfamily=a[3],this.fontName=a[4],this.version=a[5];try{this.postscriptName=a[6][0].raw.replace(/[\x00-\x19\x80-\xff]/g,"")}catch(e){this.postscriptName=a[4][0].raw.replace(/[\x00-\x19\x80-\xff]/g,"")}return this.trademark=a[7],this.manufacturer=a[8],this.designer=a[9],this.description=a[10],this.vendorUrl=a[11],this.designerUrl=a[12],this.license=a[13],this.licenseUrl=a[14],this.preferredFamily=a[15],this.preferredSubfamily=a[17],this.compatibleFull=a[18],this.sampleText=a[19]},t}(),ft=function(e){function t(){return t.__super__.constructor.apply(this,arguments)}return ot(t,et),t.prototype.tag="maxp",t.prototype.parse=function(e){return e.pos=this.offset,this.version=e.readInt(),this.numGlyphs=e.readUInt16(),this.maxPoints=e.readUInt16(),this.maxContours=e.readUInt16(),this.maxCompositePoints=e.readUInt16(),this.maxComponentContours=e.readUInt16(),this.maxZones=e.readUInt16(),this.maxTwilightPoints=e.readUInt16(),this.maxStorage=e.readUInt16(),this.maxFunctionDefs=e.readUInt16(),this.maxInstructionDefs=e.readUInt16(),this.maxStackElements=e.readUInt16(),this.maxSizeOfInstructions=e.readUInt16(),this.maxComponentElements=e.readUInt16(),this.maxComponentDepth=e.readUInt16()},t}(),ht=function(e){function t(){return t.__super__.constructor.apply(this,arguments)}return ot(t,et),t.prototype.tag="hmtx",t.prototype.parse=function(e){var t,r,n,o,s,i,a;for(e.pos=this.offset,this.metrics=[],t=0,i=this.file.hhea.numberOfMetrics;0<=i?t<i:t>i;t=0<=i?++t:--t)this.metrics.push({advance:e.readUInt16(),lsb:e.readInt16()});for(n=this.file.maxp.numGlyphs-this.file.hhea.numberOfMetrics,this.leftSideBearings=function(){var r,o;for(o=[],t=r=0;0<=n?r<n:r>n;t=0<=n?++r:--r)o.push(e.readInt16());return o}(),this.widths=function(){var e,t,r,n;for(n=[],e=0,t=(r=this.metrics).length;e<t;e++)o=r[e],n.push(o.advance);return n}.call(this),r=this.widths[this.widths.length-1],a=[],t=s=0;0<=n?s<n:s>n;t=0<=n?++s:--s)a.push(this.widths.push(r));return a},t.prototype.forGlyph=function(e){return e in this.metrics?this.metrics[e]:{advance:this.metrics[this.metrics.length-1].advance,lsb:this.leftSideBearings[e-this.metrics.length]}},t}(),pt=[].slice,mt=function(e){function t(){return t.__super__.constructor.apply(this,arguments)}return ot(t,et),t.prototype.tag="glyf",t.prototype.parse=function(){return this.cache={}},t.prototype.glyphFor=function(e){var t,r,n,o,s,i,a,A,u,c;return e in this.cache?this.cache[e]:(o=this.file.loca,t=this.file.contents,r=o.indexOf(e),0===(n=o.lengthOf(e))?this.cache[e]=null:(t.pos=this.offset+r,s=(i=new tt(t.read(n))).readShort(),A=i.readShort(),c=i.readShort(),a=i.readShort(),u=i.readShort(),this.cache[e]=-1===s?new yt(i,A,c,a,u):new gt(i,s,A,c,a,u),this.cache[e]))},t.prototype.encode=function(e,t,r){var n,o,s,i,a;for(s=[],o=[],i=0,a=t.length;i<a;i++)n=e[t[i]],o.push(s.length),n&&(s=s.concat(n.encode(r)));return o.push(s.length),{table:s,offsets:o}},t}(),gt=function(){function e(e,t,r,n,o,s){this.raw=e,this.numberOfContours=t,this.xMin=r,this.yMin=n,this.xMax=o,this.yMax=s,this.compound=!1}return e.prototype.encode=function(){return this.raw.data},e}(),yt=function(){function e(e,t,r,n,o){var s,i;for(this.raw=e,this.xMin=t,this.yMin=r,this.xMax=n,this.yMax=o,this.compound=!0,this.glyphIDs=[],this.glyphOffsets=[],s=this.raw;i=s.readShort(),this.glyphOffsets.push(s.pos),this.glyphIDs.push(s.readUInt16()),32&i;)s.pos+=1&i?4:2,128&i?s.pos+=8:64&i?s.pos+=4:8&i&&(s.pos+=2)}return e.prototype.encode=function(){var e,t,r;for(t=new tt(pt.call(this.raw.data)),e=0,r=this.glyphIDs.length;e<r;++e)t.pos=this.glyphOffsets[e];return t.data},e}(),vt=function(e){function t(){return t.__super__.constructor.apply(this,arguments)}return ot(t,et),t.prototype.tag="loca",t.prototype.parse=function(e){var t,r;return e.pos=this.offset,t=this.file.head.indexToLocFormat,this.offsets=0===t?function(){var t,n;for(n=[],r=0,t=this.length;r<t;r+=2)n.push(2*e.readUInt16());return n}.call(this):function(){var t,n;for(n=[],r=0,t=this.length;r<t;r+=4)n.push(e.readUInt32());return n}.call(this)},t.prototype.indexOf=function(e){return this.offsets[e]},t.prototype.lengthOf=function(e){return this.offsets[e+1]-this.offsets[e]},t.prototype.encode=function(e,t){for(var r=new Uint32Array(this.offsets.length),n=0,o=0,s=0;s<r.length;++s)if(r[s]=n,o<t.length&&t[o]==s){++o,r[s]=n;var i=this.offsets[s],a=this.offsets[s+1]-i;a>0&&(n+=a)}for(var A=new Array(4*r.length),u=0;u<r.length;++u)A[4*u+3]=255&r[u],A[4*u+2]=(65280&r[u])>>8,A[4*u+1]=(16711680&r[u])>>16,A[4*u]=(4278190080&r[u])>>24;return A},t}(),wt=function(){function e(e){this.font=e,this.subset={},this.unicodes={},this.next=33}return e.prototype.generateCmap=function(){var e,t,r,n,o;for(t in n=this.font.cmap.tables[0].codeMap,e={},o=this.subset)r=o[t],e[t]=n[r];return e},e.prototype.glyphsFor=function(e){var t,r,n,o,s,i,a;for(n={},s=0,i=e.length;s<i;s++)n[o=e[s]]=this.font.glyf.glyphFor(o);for(o in t=[],n)(null!=(r=n[o])?r.compound:void 0)&&t.push.apply(t,r.glyphIDs);if(t.length>0)for(o in a=this.glyphsFor(t))r=a[o],n[o]=r;return n},e.prototype.encode=function(e,t){var r,n,o,s,i,a,A,u,c,l,d,f,h,p,m;for(n in r=at.encode(this.generateCmap(),"unicode"),s=this.glyphsFor(e),d={0:0},m=r.charMap)d[(a=m[n]).old]=a.new;for(f in l=r.maxGlyphID,s)f in d||(d[f]=l++);return u=function(e){var t,r;for(t in r={},e)r[e[t]]=t;return r}(d),c=Object.keys(u).sort((function(e,t){return e-t})),h=function(){var e,t,r;for(r=[],e=0,t=c.length;e<t;e++)i=c[e],r.push(u[i]);return r}(),o=this.font.glyf.encode(s,h,d),A=this.font.loca.encode(o.offsets,h),p={cmap:this.font.cmap.raw(),glyf:o.table,loca:A,hmtx:this.font.hmtx.raw(),hhea:this.font.hhea.raw(),maxp:this.font.maxp.raw(),post:this.font.post.raw(),name:this.font.name.raw(),head:this.font.head.encode(t)},this.font.os2.exists&&(p["OS/2"]=this.font.os2.raw()),this.font.directory.encode(p)},e}();H.API.PDFObject=function(){var e;function t(){}return e=function(e,t){return(Array(t+1).join("0")+e).slice(-t)},t.convert=function(r){var n,o,s,i;if(Array.isArray(r))return"["+function(){var e,o,s;for(s=[],e=0,o=r.length;e<o;e++)n=r[e],s.push(t.convert(n));return s}().join(" ")+"]";if("string"==typeof r)return"/"+r;if(null!=r?r.isString:void 0)return"("+r+")";if(r instanceof Date)return"(D:"+e(r.getUTCFullYear(),4)+e(r.getUTCMonth(),2)+e(r.getUTCDate(),2)+e(r.getUTCHours(),2)+e(r.getUTCMinutes(),2)+e(r.getUTCSeconds(),2)+"Z)";if("[object Object]"==={}.toString.call(r)){for(o in s=["<<"],r)i=r[o],s.push("/"+o+" "+t.convert(i));return s.push(">>"),s.join("\n")}return""+r},t}(),t.default=H},"./node_modules/performance-now/lib/performance-now.js":function(e){(function(){var t,r,n,o,s,i;"undefined"!=typeof performance&&null!==performance&&performance.now?e.exports=function(){return performance.now()}:"undefined"!=typeof process&&null!==process&&process.hrtime?(e.exports=function(){return(t()-s)/1e6},r=process.hrtime,o=(t=function(){var e;return 1e9*(e=r())[0]+e[1]})(),i=1e9*process.uptime(),s=o-i):Date.now?(e.exports=function(){return Date.now()-n},n=Date.now()):(e.exports=function(){return(new Date).getTime()-n},n=(new Date).getTime())}).call(this)},"./node_modules/raf/index.js":function(e,t,r){for(var n=r("./node_modules/performance-now/lib/performance-now.js"),o="undefined"==typeof window?global:window,s=["moz","webkit"],i="AnimationFrame",a=o["request"+i],A=o["cancel"+i]||o["cancelRequest"+i],u=0;!a&&u<s.length;u++)a=o[s[u]+"Request"+i],A=o[s[u]+"Cancel"+i]||o[s[u]+"CancelRequest"+i];if(!a||!A){var c=0,l=0,d=[];a=function(e){if(0===d.length){var t=n(),r=Math.max(0,16.666666666666668-(t-c));c=r+t,setTimeout((function(){var e=d.slice(0);d.length=0;for(var t=0;t<e.length;t++)if(!e[t].cancelled)try{e[t].callback(c)}catch(e){setTimeout((function(){throw e}),0)}}),Math.round(r))}return d.push({handle:++l,callback:e,cancelled:!1}),l},A=function(e){for(var t=0;t<d.length;t++)d[t].handle===e&&(d[t].cancelled=!0)}}e.exports=function(e){return a.call(o,e)},e.exports.cancel=function(){A.apply(o,arguments)},e.exports.polyfill=function(e){e||(e=o),e.requestAnimationFrame=a,e.cancelAnimationFrame=A}},"./node_modules/regenerator-runtime/runtime.js":function(e){var t=function(e){"use strict";var t,r=Object.prototype,n=r.hasOwnProperty,o="function"==typeof Symbol?Symbol:{},s=o.iterator||"@@iterator",i=o.asyncIterator||"@@asyncIterator",a=o.toStringTag||"@@toStringTag";function A(e,t,r){return Object.defineProperty(e,t,{value:r,enumerable:!0,configurable:!0,writable:!0}),e[t]}try{A({},"")}catch(e){A=function(e,t,r){return e[t]=r}}function u(e,t,r,n){var o=t&&t.prototype instanceof m?t:m,s=Object.create(o.prototype),i=new N(n||[]);return s._invoke=function(e,t,r){var n=l;return function(o,s){if(n===f)throw new Error("Generator is already running");if(n===h){if("throw"===o)throw s;return F()}for(r.method=o,r.arg=s;;){var i=r.delegate;if(i){var a=C(i,r);if(a){if(a===p)continue;return a}}if("next"===r.method)r.sent=r._sent=r.arg;else if("throw"===r.method){if(n===l)throw n=h,r.arg;r.dispatchException(r.arg)}else"return"===r.method&&r.abrupt("return",r.arg);n=f;var A=c(e,t,r);if("normal"===A.type){if(n=r.done?h:d,A.arg===p)continue;return{value:A.arg,done:r.done}}"throw"===A.type&&(n=h,r.method="throw",r.arg=A.arg)}}}(e,r,i),s}function c(e,t,r){try{return{type:"normal",arg:e.call(t,r)}}catch(e){return{type:"throw",arg:e}}}e.wrap=u;var l="suspendedStart",d="suspendedYield",f="executing",h="completed",p={};function m(){}function g(){}function y(){}var v={};A(v,s,(function(){return this}));var w=Object.getPrototypeOf,b=w&&w(w(Q([])));b&&b!==r&&n.call(b,s)&&(v=b);var B=y.prototype=m.prototype=Object.create(v);function j(e){["next","throw","return"].forEach((function(t){A(e,t,(function(e){return this._invoke(t,e)}))}))}function _(e,t){function r(o,s,i,a){var A=c(e[o],e,s);if("throw"!==A.type){var u=A.arg,l=u.value;return l&&"object"==typeof l&&n.call(l,"__await")?t.resolve(l.__await).then((function(e){r("next",e,i,a)}),(function(e){r("throw",e,i,a)})):t.resolve(l).then((function(e){u.value=e,i(u)}),(function(e){return r("throw",e,i,a)}))}a(A.arg)}var o;this._invoke=function(e,n){function s(){return new t((function(t,o){r(e,n,t,o)}))}return o=o?o.then(s,s):s()}}function C(e,r){var n=e.iterator[r.method];if(n===t){if(r.delegate=null,"throw"===r.method){if(e.iterator.return&&(r.method="return",r.arg=t,C(e,r),"throw"===r.method))return p;r.method="throw",r.arg=new TypeError("The iterator does not provide a 'throw' method")}return p}var o=c(n,e.iterator,r.arg);if("throw"===o.type)return r.method="throw",r.arg=o.arg,r.delegate=null,p;var s=o.arg;return s?s.done?(r[e.resultName]=s.value,r.next=e.nextLoc,"return"!==r.method&&(r.method="next",r.arg=t),r.delegate=null,p):s:(r.method="throw",r.arg=new TypeError("iterator result is not an object"),r.delegate=null,p)}function x(e){var t={tryLoc:e[0]};1 in e&&(t.catchLoc=e[1]),2 in e&&(t.finallyLoc=e[2],t.afterLoc=e[3]),this.tryEntries.push(t)}function E(e){var t=e.completion||{};t.type="normal",delete t.arg,e.completion=t}function N(e){this.tryEntries=[{tryLoc:"root"}],e.forEach(x,this),this.reset(!0)}function Q(e){if(e){var r=e[s];if(r)return r.call(e);if("function"==typeof e.next)return e;if(!isNaN(e.length)){var o=-1,i=function r(){for(;++o<e.length;)if(n.call(e,o))return r.value=e[o],r.done=!1,r;return r.value=t,r.done=!0,r};return i.next=i}}return{next:F}}function F(){return{value:t,done:!0}}return g.prototype=y,A(B,"constructor",y),A(y,"constructor",g),g.displayName=A(y,a,"GeneratorFunction"),e.isGeneratorFunction=function(e){var t="function"==typeof e&&e.constructor;return!!t&&(t===g||"GeneratorFunction"===(t.displayName||t.name))},e.mark=function(e){return Object.setPrototypeOf?Object.setPrototypeOf(e,y):(e.__proto__=y,A(e,a,"GeneratorFunction")),e.prototype=Object.create(B),e},e.awrap=function(e){return{__await:e}},j(_.prototype),A(_.prototype,i,(function(){return this})),e.AsyncIterator=_,e.async=function(t,r,n,o,s){void 0===s&&(s=Promise);var i=new _(u(t,r,n,o),s);return e.isGeneratorFunction(r)?i:i.next().then((function(e){return e.done?e.value:i.next()}))},j(B),A(B,a,"Generator"),A(B,s,(function(){return this})),A(B,"toString",(function(){return"[object Generator]"})),e.keys=function(e){var t=[];for(var r in e)t.push(r);return t.reverse(),function r(){for(;t.length;){var n=t.pop();if(n in e)return r.value=n,r.done=!1,r}return r.done=!0,r}},e.values=Q,N.prototype={constructor:N,reset:function(e){if(this.prev=0,this.next=0,this.sent=this._sent=t,this.done=!1,this.delegate=null,this.method="next",this.arg=t,this.tryEntries.forEach(E),!e)for(var r in this)"t"===r.charAt(0)&&n.call(this,r)&&!isNaN(+r.slice(1))&&(this[r]=t)},stop:function(){this.done=!0;var e=this.tryEntries[0].completion;if("throw"===e.type)throw e.arg;return this.rval},dispatchException:function(e){if(this.done)throw e;var r=this;function o(n,o){return a.type="throw",a.arg=e,r.next=n,o&&(r.method="next",r.arg=t),!!o}for(var s=this.tryEntries.length-1;s>=0;--s){var i=this.tryEntries[s],a=i.completion;if("root"===i.tryLoc)return o("end");if(i.tryLoc<=this.prev){var A=n.call(i,"catchLoc"),u=n.call(i,"finallyLoc");if(A&&u){if(this.prev<i.catchLoc)return o(i.catchLoc,!0);if(this.prev<i.finallyLoc)return o(i.finallyLoc)}else if(A){if(this.prev<i.catchLoc)return o(i.catchLoc,!0)}else{if(!u)throw new Error("try statement without catch or finally");if(this.prev<i.finallyLoc)return o(i.finallyLoc)}}}},abrupt:function(e,t){for(var r=this.tryEntries.length-1;r>=0;--r){var o=this.tryEntries[r];if(o.tryLoc<=this.prev&&n.call(o,"finallyLoc")&&this.prev<o.finallyLoc){var s=o;break}}s&&("break"===e||"continue"===e)&&s.tryLoc<=t&&t<=s.finallyLoc&&(s=null);var i=s?s.completion:{};return i.type=e,i.arg=t,s?(this.method="next",this.next=s.finallyLoc,p):this.complete(i)},complete:function(e,t){if("throw"===e.type)throw e.arg;return"break"===e.type||"continue"===e.type?this.next=e.arg:"return"===e.type?(this.rval=this.arg=e.arg,this.method="return",this.next="end"):"normal"===e.type&&t&&(this.next=t),p},finish:function(e){for(var t=this.tryEntries.length-1;t>=0;--t){var r=this.tryEntries[t];if(r.finallyLoc===e)return this.complete(r.completion,r.afterLoc),E(r),p}},catch:function(e){for(var t=this.tryEntries.length-1;t>=0;--t){var r=this.tryEntries[t];if(r.tryLoc===e){var n=r.completion;if("throw"===n.type){var o=n.arg;E(r)}return o}}throw new Error("illegal catch attempt")},delegateYield:function(e,r,n){return this.delegate={iterator:Q(e),resultName:r,nextLoc:n},"next"===this.method&&(this.arg=t),p}},e}(e.exports);try{regeneratorRuntime=t}catch(e){"object"==typeof globalThis?globalThis.regeneratorRuntime=t:Function("r","regeneratorRuntime = r")(t)}},"./node_modules/rgbcolor/index.js":function(e){e.exports=function(e){this.ok=!1,this.alpha=1,"#"==e.charAt(0)&&(e=e.substr(1,6)),e=(e=e.replace(/ /g,"")).toLowerCase();var t={aliceblue:"f0f8ff",antiquewhite:"faebd7",aqua:"00ffff",aquamarine:"7fffd4",azure:"f0ffff",beige:"f5f5dc",bisque:"ffe4c4",black:"000000",blanchedalmond:"ffebcd",blue:"0000ff",blueviolet:"8a2be2",brown:"a52a2a",burlywood:"deb887",cadetblue:"5f9ea0",chartreuse:"7fff00",chocolate:"d2691e",coral:"ff7f50",cornflowerblue:"6495ed",cornsilk:"fff8dc",crimson:"dc143c",cyan:"00ffff",darkblue:"00008b",darkcyan:"008b8b",darkgoldenrod:"b8860b",darkgray:"a9a9a9",darkgreen:"006400",darkkhaki:"bdb76b",darkmagenta:"8b008b",darkolivegreen:"556b2f",darkorange:"ff8c00",darkorchid:"9932cc",darkred:"8b0000",darksalmon:"e9967a",darkseagreen:"8fbc8f",darkslateblue:"483d8b",darkslategray:"2f4f4f",darkturquoise:"00ced1",darkviolet:"9400d3",deeppink:"ff1493",deepskyblue:"00bfff",dimgray:"696969",dodgerblue:"1e90ff",feldspar:"d19275",firebrick:"b22222",floralwhite:"fffaf0",forestgreen:"228b22",fuchsia:"ff00ff",gainsboro:"dcdcdc",ghostwhite:"f8f8ff",gold:"ffd700",goldenrod:"daa520",gray:"808080",green:"008000",greenyellow:"adff2f",honeydew:"f0fff0",hotpink:"ff69b4",indianred:"cd5c5c",indigo:"4b0082",ivory:"fffff0",khaki:"f0e68c",lavender:"e6e6fa",lavenderblush:"fff0f5",lawngreen:"7cfc00",lemonchiffon:"fffacd",lightblue:"add8e6",lightcoral:"f08080",lightcyan:"e0ffff",lightgoldenrodyellow:"fafad2",lightgrey:"d3d3d3",lightgreen:"90ee90",lightpink:"ffb6c1",lightsalmon:"ffa07a",lightseagreen:"20b2aa",lightskyblue:"87cefa",lightslateblue:"8470ff",lightslategray:"778899",lightsteelblue:"b0c4de",lightyellow:"ffffe0",lime:"00ff00",limegreen:"32cd32",linen:"faf0e6",magenta:"ff00ff",maroon:"800000",mediumaquamarine:"66cdaa",mediumblue:"0000cd",mediumorchid:"ba55d3",mediumpurple:"9370d8",mediumseagreen:"3cb371",mediumslateblue:"7b68ee",mediumspringgreen:"00fa9a",mediumturquoise:"48d1cc",mediumvioletred:"c71585",midnightblue:"191970",mintcream:"f5fffa",mistyrose:"ffe4e1",moccasin:"ffe4b5",navajowhite:"ffdead",navy:"000080",oldlace:"fdf5e6",olive:"808000",olivedrab:"6b8e23",orange:"ffa500",orangered:"ff4500",orchid:"da70d6",palegoldenrod:"eee8aa",palegreen:"98fb98",paleturquoise:"afeeee",palevioletred:"d87093",papayawhip:"ffefd5",peachpuff:"ffdab9",peru:"cd853f",pink:"ffc0cb",plum:"dda0dd",powderblue:"b0e0e6",purple:"800080",rebeccapurple:"663399",red:"ff0000",rosybrown:"bc8f8f",royalblue:"4169e1",saddlebrown:"8b4513",salmon:"fa8072",sandybrown:"f4a460",seagreen:"2e8b57",seashell:"fff5ee",sienna:"a0522d",silver:"c0c0c0",skyblue:"87ceeb",slateblue:"6a5acd",slategray:"708090",snow:"fffafa",springgreen:"00ff7f",steelblue:"4682b4",tan:"d2b48c",teal:"008080",thistle:"d8bfd8",tomato:"ff6347",turquoise:"40e0d0",violet:"ee82ee",violetred:"d02090",wheat:"f5deb3",white:"ffffff",whitesmoke:"f5f5f5",yellow:"ffff00",yellowgreen:"9acd32"};e=t[e]||e;for(var r=[{re:/^rgba\((\d{1,3}),\s*(\d{1,3}),\s*(\d{1,3}),\s*((?:\d?\.)?\d)\)$/,example:["rgba(123, 234, 45, 0.8)","rgba(255,234,245,1.0)"],process:function(e){return[parseInt(e[1]),parseInt(e[2]),parseInt(e[3]),parseFloat(e[4])]}},{re:/^rgb\((\d{1,3}),\s*(\d{1,3}),\s*(\d{1,3})\)$/,example:["rgb(123, 234, 45)","rgb(255,234,245)"],process:function(e){return[parseInt(e[1]),parseInt(e[2]),parseInt(e[3])]}},{re:/^([0-9a-fA-F]{2})([0-9a-fA-F]{2})([0-9a-fA-F]{2})$/,example:["#00ff00","336699"],process:function(e){return[parseInt(e[1],16),parseInt(e[2],16),parseInt(e[3],16)]}},{re:/^([0-9a-fA-F]{1})([0-9a-fA-F]{1})([0-9a-fA-F]{1})$/,example:["#fb0","f0f"],process:function(e){return[parseInt(e[1]+e[1],16),parseInt(e[2]+e[2],16),parseInt(e[3]+e[3],16)]}}],n=0;n<r.length;n++){var o=r[n].re,s=r[n].process,i=o.exec(e);if(i){var a=s(i);this.r=a[0],this.g=a[1],this.b=a[2],a.length>3&&(this.alpha=a[3]),this.ok=!0}}this.r=this.r<0||isNaN(this.r)?0:this.r>255?255:this.r,this.g=this.g<0||isNaN(this.g)?0:this.g>255?255:this.g,this.b=this.b<0||isNaN(this.b)?0:this.b>255?255:this.b,this.alpha=this.alpha<0?0:this.alpha>1||isNaN(this.alpha)?1:this.alpha,this.toRGB=function(){return"rgb("+this.r+", "+this.g+", "+this.b+")"},this.toRGBA=function(){return"rgba("+this.r+", "+this.g+", "+this.b+", "+this.alpha+")"},this.toHex=function(){var e=this.r.toString(16),t=this.g.toString(16),r=this.b.toString(16);return 1==e.length&&(e="0"+e),1==t.length&&(t="0"+t),1==r.length&&(r="0"+r),"#"+e+t+r},this.getHelpXML=function(){for(var e=new Array,n=0;n<r.length;n++)for(var o=r[n].example,s=0;s<o.length;s++)e[e.length]=o[s];for(var i in t)e[e.length]=i;var a=document.createElement("ul");for(a.setAttribute("id","rgbcolor-examples"),n=0;n<e.length;n++)try{var A=document.createElement("li"),u=new RGBColor(e[n]),c=document.createElement("div");c.style.cssText="margin: 3px; border: 1px solid black; background:"+u.toHex()+"; color:"+u.toHex(),c.appendChild(document.createTextNode("test"));var l=document.createTextNode(" "+e[n]+" -> "+u.toRGB()+" -> "+u.toHex());A.appendChild(c),A.appendChild(l),a.appendChild(A)}catch(e){}return a}}},"./node_modules/stackblur-canvas/dist/stackblur-es.js":function(e,t,r){"use strict";function n(e){return(n="function"==typeof Symbol&&"symbol"==typeof Symbol.iterator?function(e){return typeof e}:function(e){return e&&"function"==typeof Symbol&&e.constructor===Symbol&&e!==Symbol.prototype?"symbol":typeof e})(e)}r.r(t),r.d(t,{BlurStack:function(){return d},canvasRGB:function(){return c},canvasRGBA:function(){return A},image:function(){return i},imageDataRGB:function(){return l},imageDataRGBA:function(){return u}});var o=[512,512,456,512,328,456,335,512,405,328,271,456,388,335,292,512,454,405,364,328,298,271,496,456,420,388,360,335,312,292,273,512,482,454,428,405,383,364,345,328,312,298,284,271,259,496,475,456,437,420,404,388,374,360,347,335,323,312,302,292,282,273,265,512,497,482,468,454,441,428,417,405,394,383,373,364,354,345,337,328,320,312,305,298,291,284,278,271,265,259,507,496,485,475,465,456,446,437,428,420,412,404,396,388,381,374,367,360,354,347,341,335,329,323,318,312,307,302,297,292,287,282,278,273,269,265,261,512,505,497,489,482,475,468,461,454,447,441,435,428,422,417,411,405,399,394,389,383,378,373,368,364,359,354,350,345,341,337,332,328,324,320,316,312,309,305,301,298,294,291,287,284,281,278,274,271,268,265,262,259,257,507,501,496,491,485,480,475,470,465,460,456,451,446,442,437,433,428,424,420,416,412,408,404,400,396,392,388,385,381,377,374,370,367,363,360,357,354,350,347,344,341,338,335,332,329,326,323,320,318,315,312,310,307,304,302,299,297,294,292,289,287,285,282,280,278,275,273,271,269,267,265,263,261,259],s=[9,11,12,13,13,14,14,15,15,15,15,16,16,16,16,17,17,17,17,17,17,17,18,18,18,18,18,18,18,18,18,19,19,19,19,19,19,19,19,19,19,19,19,19,19,20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,22,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,23,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24,24];function i(e,t,r,n,o,s){if("string"==typeof e&&(e=document.getElementById(e)),e&&"naturalWidth"in e){var i=o?"offset":"natural",a=e[i+"Width"],u=e[i+"Height"];if("string"==typeof t&&(t=document.getElementById(t)),t&&"getContext"in t){s||(t.style.width=a+"px",t.style.height=u+"px"),t.width=a,t.height=u;var l=t.getContext("2d");l.clearRect(0,0,a,u),l.drawImage(e,0,0,e.naturalWidth,e.naturalHeight,0,0,a,u),isNaN(r)||r<1||(n?A(t,0,0,a,u,r):c(t,0,0,a,u,r))}}}function a(e,t,r,o,s){if("string"==typeof e&&(e=document.getElementById(e)),!e||"object"!==n(e)||!("getContext"in e))throw new TypeError("Expecting canvas with `getContext` method in processCanvasRGB(A) calls!");var i=e.getContext("2d");try{return i.getImageData(t,r,o,s)}catch(e){throw new Error("unable to access image data: "+e)}}function A(e,t,r,n,o,s){if(!(isNaN(s)||s<1)){s|=0;var i=a(e,t,r,n,o);i=u(i,0,0,n,o,s),e.getContext("2d").putImageData(i,t,r)}}function u(e,t,r,n,i,a){for(var A,u=e.data,c=2*a+1,l=n-1,f=i-1,h=a+1,p=h*(h+1)/2,m=new d,g=m,y=1;y<c;y++)g=g.next=new d,y===h&&(A=g);g.next=m;for(var v=null,w=null,b=0,B=0,j=o[a],_=s[a],C=0;C<i;C++){g=m;for(var x=u[B],E=u[B+1],N=u[B+2],Q=u[B+3],F=0;F<h;F++)g.r=x,g.g=E,g.b=N,g.a=Q,g=g.next;for(var U=0,S=0,L=0,T=0,H=h*x,I=h*E,P=h*N,O=h*Q,k=p*x,R=p*E,M=p*N,D=p*Q,K=1;K<h;K++){var z=B+((l<K?l:K)<<2),V=u[z],q=u[z+1],G=u[z+2],X=u[z+3],W=h-K;k+=(g.r=V)*W,R+=(g.g=q)*W,M+=(g.b=G)*W,D+=(g.a=X)*W,U+=V,S+=q,L+=G,T+=X,g=g.next}v=m,w=A;for(var J=0;J<n;J++){var Y=D*j>>_;if(u[B+3]=Y,0!==Y){var Z=255/Y;u[B]=(k*j>>_)*Z,u[B+1]=(R*j>>_)*Z,u[B+2]=(M*j>>_)*Z}else u[B]=u[B+1]=u[B+2]=0;k-=H,R-=I,M-=P,D-=O,H-=v.r,I-=v.g,P-=v.b,O-=v.a;var $=J+a+1;$=b+($<l?$:l)<<2,k+=U+=v.r=u[$],R+=S+=v.g=u[$+1],M+=L+=v.b=u[$+2],D+=T+=v.a=u[$+3],v=v.next;var ee=w,te=ee.r,re=ee.g,ne=ee.b,oe=ee.a;H+=te,I+=re,P+=ne,O+=oe,U-=te,S-=re,L-=ne,T-=oe,w=w.next,B+=4}b+=n}for(var se=0;se<n;se++){var ie=u[B=se<<2],ae=u[B+1],Ae=u[B+2],ue=u[B+3],ce=h*ie,le=h*ae,de=h*Ae,fe=h*ue,he=p*ie,pe=p*ae,me=p*Ae,ge=p*ue;g=m;for(var ye=0;ye<h;ye++)g.r=ie,g.g=ae,g.b=Ae,g.a=ue,g=g.next;for(var ve=n,we=0,be=0,Be=0,je=0,_e=1;_e<=a;_e++){B=ve+se<<2;var Ce=h-_e;he+=(g.r=ie=u[B])*Ce,pe+=(g.g=ae=u[B+1])*Ce,me+=(g.b=Ae=u[B+2])*Ce,ge+=(g.a=ue=u[B+3])*Ce,je+=ie,we+=ae,be+=Ae,Be+=ue,g=g.next,_e<f&&(ve+=n)}B=se,v=m,w=A;for(var xe=0;xe<i;xe++){var Ee=B<<2;u[Ee+3]=ue=ge*j>>_,ue>0?(ue=255/ue,u[Ee]=(he*j>>_)*ue,u[Ee+1]=(pe*j>>_)*ue,u[Ee+2]=(me*j>>_)*ue):u[Ee]=u[Ee+1]=u[Ee+2]=0,he-=ce,pe-=le,me-=de,ge-=fe,ce-=v.r,le-=v.g,de-=v.b,fe-=v.a,Ee=se+((Ee=xe+h)<f?Ee:f)*n<<2,he+=je+=v.r=u[Ee],pe+=we+=v.g=u[Ee+1],me+=be+=v.b=u[Ee+2],ge+=Be+=v.a=u[Ee+3],v=v.next,ce+=ie=w.r,le+=ae=w.g,de+=Ae=w.b,fe+=ue=w.a,je-=ie,we-=ae,be-=Ae,Be-=ue,w=w.next,B+=n}}return e}function c(e,t,r,n,o,s){if(!(isNaN(s)||s<1)){s|=0;var i=a(e,t,r,n,o);i=l(i,0,0,n,o,s),e.getContext("2d").putImageData(i,t,r)}}function l(e,t,r,n,i,a){for(var A,u=e.data,c=2*a+1,l=n-1,f=i-1,h=a+1,p=h*(h+1)/2,m=new d,g=m,y=1;y<c;y++)g=g.next=new d,y===h&&(A=g);g.next=m;for(var v,w,b=null,B=null,j=o[a],_=s[a],C=0,x=0,E=0;E<i;E++){var N=u[x],Q=u[x+1],F=u[x+2],U=h*N,S=h*Q,L=h*F,T=p*N,H=p*Q,I=p*F;g=m;for(var P=0;P<h;P++)g.r=N,g.g=Q,g.b=F,g=g.next;for(var O=0,k=0,R=0,M=1;M<h;M++)v=x+((l<M?l:M)<<2),T+=(g.r=N=u[v])*(w=h-M),H+=(g.g=Q=u[v+1])*w,I+=(g.b=F=u[v+2])*w,O+=N,k+=Q,R+=F,g=g.next;b=m,B=A;for(var D=0;D<n;D++)u[x]=T*j>>_,u[x+1]=H*j>>_,u[x+2]=I*j>>_,T-=U,H-=S,I-=L,U-=b.r,S-=b.g,L-=b.b,v=C+((v=D+a+1)<l?v:l)<<2,T+=O+=b.r=u[v],H+=k+=b.g=u[v+1],I+=R+=b.b=u[v+2],b=b.next,U+=N=B.r,S+=Q=B.g,L+=F=B.b,O-=N,k-=Q,R-=F,B=B.next,x+=4;C+=n}for(var K=0;K<n;K++){var z=u[x=K<<2],V=u[x+1],q=u[x+2],G=h*z,X=h*V,W=h*q,J=p*z,Y=p*V,Z=p*q;g=m;for(var $=0;$<h;$++)g.r=z,g.g=V,g.b=q,g=g.next;for(var ee=0,te=0,re=0,ne=1,oe=n;ne<=a;ne++)x=oe+K<<2,J+=(g.r=z=u[x])*(w=h-ne),Y+=(g.g=V=u[x+1])*w,Z+=(g.b=q=u[x+2])*w,ee+=z,te+=V,re+=q,g=g.next,ne<f&&(oe+=n);x=K,b=m,B=A;for(var se=0;se<i;se++)u[v=x<<2]=J*j>>_,u[v+1]=Y*j>>_,u[v+2]=Z*j>>_,J-=G,Y-=X,Z-=W,G-=b.r,X-=b.g,W-=b.b,v=K+((v=se+h)<f?v:f)*n<<2,J+=ee+=b.r=u[v],Y+=te+=b.g=u[v+1],Z+=re+=b.b=u[v+2],b=b.next,G+=z=B.r,X+=V=B.g,W+=q=B.b,ee-=z,te-=V,re-=q,B=B.next,x+=n}return e}var d=function e(){!function(e,t){if(!(e instanceof t))throw new TypeError("Cannot call a class as a function")}(this,e),this.r=0,this.g=0,this.b=0,this.a=0,this.next=null}},"./node_modules/svg-pathdata/lib/SVGPathData.module.js":function(e,t,r){"use strict";r.r(t),r.d(t,{COMMAND_ARG_COUNTS:function(){return j},SVGPathData:function(){return B},SVGPathDataParser:function(){return b},SVGPathDataTransformer:function(){return l},encodeSVGPath:function(){return s}});var n=function(e,t){return(n=Object.setPrototypeOf||{__proto__:[]}instanceof Array&&function(e,t){e.__proto__=t}||function(e,t){for(var r in t)t.hasOwnProperty(r)&&(e[r]=t[r])})(e,t)};function o(e,t){function r(){this.constructor=e}n(e,t),e.prototype=null===t?Object.create(t):(r.prototype=t.prototype,new r)}function s(e){var t="";Array.isArray(e)||(e=[e]);for(var r=0;r<e.length;r++){var n=e[r];if(n.type===B.CLOSE_PATH)t+="z";else if(n.type===B.HORIZ_LINE_TO)t+=(n.relative?"h":"H")+n.x;else if(n.type===B.VERT_LINE_TO)t+=(n.relative?"v":"V")+n.y;else if(n.type===B.MOVE_TO)t+=(n.relative?"m":"M")+n.x+" "+n.y;else if(n.type===B.LINE_TO)t+=(n.relative?"l":"L")+n.x+" "+n.y;else if(n.type===B.CURVE_TO)t+=(n.relative?"c":"C")+n.x1+" "+n.y1+" "+n.x2+" "+n.y2+" "+n.x+" "+n.y;else if(n.type===B.SMOOTH_CURVE_TO)t+=(n.relative?"s":"S")+n.x2+" "+n.y2+" "+n.x+" "+n.y;else if(n.type===B.QUAD_TO)t+=(n.relative?"q":"Q")+n.x1+" "+n.y1+" "+n.x+" "+n.y;else if(n.type===B.SMOOTH_QUAD_TO)t+=(n.relative?"t":"T")+n.x+" "+n.y;else{if(n.type!==B.ARC)throw new Error('Unexpected command type "'+n.type+'" at index '+r+".");t+=(n.relative?"a":"A")+n.rX+" "+n.rY+" "+n.xRot+" "+ +n.lArcFlag+" "+ +n.sweepFlag+" "+n.x+" "+n.y}}return t}function i(e,t){var r=e[0],n=e[1];return[r*Math.cos(t)-n*Math.sin(t),r*Math.sin(t)+n*Math.cos(t)]}function a(){for(var e=[],t=0;t<arguments.length;t++)e[t]=arguments[t];for(var r=0;r<e.length;r++)if("number"!=typeof e[r])throw new Error("assertNumbers arguments["+r+"] is not a number. "+typeof e[r]+" == typeof "+e[r]);return!0}var A=Math.PI;function u(e,t,r){e.lArcFlag=0===e.lArcFlag?0:1,e.sweepFlag=0===e.sweepFlag?0:1;var n=e.rX,o=e.rY,s=e.x,a=e.y;n=Math.abs(e.rX),o=Math.abs(e.rY);var u=i([(t-s)/2,(r-a)/2],-e.xRot/180*A),c=u[0],l=u[1],d=Math.pow(c,2)/Math.pow(n,2)+Math.pow(l,2)/Math.pow(o,2);1<d&&(n*=Math.sqrt(d),o*=Math.sqrt(d)),e.rX=n,e.rY=o;var f=Math.pow(n,2)*Math.pow(l,2)+Math.pow(o,2)*Math.pow(c,2),h=(e.lArcFlag!==e.sweepFlag?1:-1)*Math.sqrt(Math.max(0,(Math.pow(n,2)*Math.pow(o,2)-f)/f)),p=n*l/o*h,m=-o*c/n*h,g=i([p,m],e.xRot/180*A);e.cX=g[0]+(t+s)/2,e.cY=g[1]+(r+a)/2,e.phi1=Math.atan2((l-m)/o,(c-p)/n),e.phi2=Math.atan2((-l-m)/o,(-c-p)/n),0===e.sweepFlag&&e.phi2>e.phi1&&(e.phi2-=2*A),1===e.sweepFlag&&e.phi2<e.phi1&&(e.phi2+=2*A),e.phi1*=180/A,e.phi2*=180/A}function c(e,t,r){a(e,t,r);var n=e*e+t*t-r*r;if(0>n)return[];if(0===n)return[[e*r/(e*e+t*t),t*r/(e*e+t*t)]];var o=Math.sqrt(n);return[[(e*r+t*o)/(e*e+t*t),(t*r-e*o)/(e*e+t*t)],[(e*r-t*o)/(e*e+t*t),(t*r+e*o)/(e*e+t*t)]]}var l,d=Math.PI/180;function f(e,t,r){return(1-r)*e+r*t}function h(e,t,r,n){return e+Math.cos(n/180*A)*t+Math.sin(n/180*A)*r}function p(e,t,r,n){var o=t-e,s=r-t,i=3*o+3*(n-r)-6*s,a=6*(s-o),A=3*o;return Math.abs(i)<1e-6?[-A/a]:function(e,t,r){void 0===r&&(r=1e-6);var n=e*e/4-t;if(n<-r)return[];if(n<=r)return[-e/2];var o=Math.sqrt(n);return[-e/2-o,-e/2+o]}(a/i,A/i,1e-6)}function m(e,t,r,n,o){var s=1-o;return e*(s*s*s)+t*(3*s*s*o)+r*(3*s*o*o)+n*(o*o*o)}!function(e){function t(){return o((function(e,t,r){return e.relative&&(void 0!==e.x1&&(e.x1+=t),void 0!==e.y1&&(e.y1+=r),void 0!==e.x2&&(e.x2+=t),void 0!==e.y2&&(e.y2+=r),void 0!==e.x&&(e.x+=t),void 0!==e.y&&(e.y+=r),e.relative=!1),e}))}function r(){var e=NaN,t=NaN,r=NaN,n=NaN;return o((function(o,s,i){return o.type&B.SMOOTH_CURVE_TO&&(o.type=B.CURVE_TO,e=isNaN(e)?s:e,t=isNaN(t)?i:t,o.x1=o.relative?s-e:2*s-e,o.y1=o.relative?i-t:2*i-t),o.type&B.CURVE_TO?(e=o.relative?s+o.x2:o.x2,t=o.relative?i+o.y2:o.y2):(e=NaN,t=NaN),o.type&B.SMOOTH_QUAD_TO&&(o.type=B.QUAD_TO,r=isNaN(r)?s:r,n=isNaN(n)?i:n,o.x1=o.relative?s-r:2*s-r,o.y1=o.relative?i-n:2*i-n),o.type&B.QUAD_TO?(r=o.relative?s+o.x1:o.x1,n=o.relative?i+o.y1:o.y1):(r=NaN,n=NaN),o}))}function n(){var e=NaN,t=NaN;return o((function(r,n,o){if(r.type&B.SMOOTH_QUAD_TO&&(r.type=B.QUAD_TO,e=isNaN(e)?n:e,t=isNaN(t)?o:t,r.x1=r.relative?n-e:2*n-e,r.y1=r.relative?o-t:2*o-t),r.type&B.QUAD_TO){e=r.relative?n+r.x1:r.x1,t=r.relative?o+r.y1:r.y1;var s=r.x1,i=r.y1;r.type=B.CURVE_TO,r.x1=((r.relative?0:n)+2*s)/3,r.y1=((r.relative?0:o)+2*i)/3,r.x2=(r.x+2*s)/3,r.y2=(r.y+2*i)/3}else e=NaN,t=NaN;return r}))}function o(e){var t=0,r=0,n=NaN,o=NaN;return function(s){if(isNaN(n)&&!(s.type&B.MOVE_TO))throw new Error("path must start with moveto");var i=e(s,t,r,n,o);return s.type&B.CLOSE_PATH&&(t=n,r=o),void 0!==s.x&&(t=s.relative?t+s.x:s.x),void 0!==s.y&&(r=s.relative?r+s.y:s.y),s.type&B.MOVE_TO&&(n=t,o=r),i}}function s(e,t,r,n,s,i){return a(e,t,r,n,s,i),o((function(o,a,A,u){var c=o.x1,l=o.x2,d=o.relative&&!isNaN(u),f=void 0!==o.x?o.x:d?0:a,h=void 0!==o.y?o.y:d?0:A;function p(e){return e*e}o.type&B.HORIZ_LINE_TO&&0!==t&&(o.type=B.LINE_TO,o.y=o.relative?0:A),o.type&B.VERT_LINE_TO&&0!==r&&(o.type=B.LINE_TO,o.x=o.relative?0:a),void 0!==o.x&&(o.x=o.x*e+h*r+(d?0:s)),void 0!==o.y&&(o.y=f*t+o.y*n+(d?0:i)),void 0!==o.x1&&(o.x1=o.x1*e+o.y1*r+(d?0:s)),void 0!==o.y1&&(o.y1=c*t+o.y1*n+(d?0:i)),void 0!==o.x2&&(o.x2=o.x2*e+o.y2*r+(d?0:s)),void 0!==o.y2&&(o.y2=l*t+o.y2*n+(d?0:i));var m=e*n-t*r;if(void 0!==o.xRot&&(1!==e||0!==t||0!==r||1!==n))if(0===m)delete o.rX,delete o.rY,delete o.xRot,delete o.lArcFlag,delete o.sweepFlag,o.type=B.LINE_TO;else{var g=o.xRot*Math.PI/180,y=Math.sin(g),v=Math.cos(g),w=1/p(o.rX),b=1/p(o.rY),j=p(v)*w+p(y)*b,_=2*y*v*(w-b),C=p(y)*w+p(v)*b,x=j*n*n-_*t*n+C*t*t,E=_*(e*n+t*r)-2*(j*r*n+C*e*t),N=j*r*r-_*e*r+C*e*e,Q=(Math.atan2(E,x-N)+Math.PI)%Math.PI/2,F=Math.sin(Q),U=Math.cos(Q);o.rX=Math.abs(m)/Math.sqrt(x*p(U)+E*F*U+N*p(F)),o.rY=Math.abs(m)/Math.sqrt(x*p(F)-E*F*U+N*p(U)),o.xRot=180*Q/Math.PI}return void 0!==o.sweepFlag&&0>m&&(o.sweepFlag=+!o.sweepFlag),o}))}e.ROUND=function(e){function t(t){return Math.round(t*e)/e}return void 0===e&&(e=1e13),a(e),function(e){return void 0!==e.x1&&(e.x1=t(e.x1)),void 0!==e.y1&&(e.y1=t(e.y1)),void 0!==e.x2&&(e.x2=t(e.x2)),void 0!==e.y2&&(e.y2=t(e.y2)),void 0!==e.x&&(e.x=t(e.x)),void 0!==e.y&&(e.y=t(e.y)),void 0!==e.rX&&(e.rX=t(e.rX)),void 0!==e.rY&&(e.rY=t(e.rY)),e}},e.TO_ABS=t,e.TO_REL=function(){return o((function(e,t,r){return e.relative||(void 0!==e.x1&&(e.x1-=t),void 0!==e.y1&&(e.y1-=r),void 0!==e.x2&&(e.x2-=t),void 0!==e.y2&&(e.y2-=r),void 0!==e.x&&(e.x-=t),void 0!==e.y&&(e.y-=r),e.relative=!0),e}))},e.NORMALIZE_HVZ=function(e,t,r){return void 0===e&&(e=!0),void 0===t&&(t=!0),void 0===r&&(r=!0),o((function(n,o,s,i,a){if(isNaN(i)&&!(n.type&B.MOVE_TO))throw new Error("path must start with moveto");return t&&n.type&B.HORIZ_LINE_TO&&(n.type=B.LINE_TO,n.y=n.relative?0:s),r&&n.type&B.VERT_LINE_TO&&(n.type=B.LINE_TO,n.x=n.relative?0:o),e&&n.type&B.CLOSE_PATH&&(n.type=B.LINE_TO,n.x=n.relative?i-o:i,n.y=n.relative?a-s:a),n.type&B.ARC&&(0===n.rX||0===n.rY)&&(n.type=B.LINE_TO,delete n.rX,delete n.rY,delete n.xRot,delete n.lArcFlag,delete n.sweepFlag),n}))},e.NORMALIZE_ST=r,e.QT_TO_C=n,e.INFO=o,e.SANITIZE=function(e){void 0===e&&(e=0),a(e);var t=NaN,r=NaN,n=NaN,s=NaN;return o((function(o,i,a,A,u){var c=Math.abs,l=!1,d=0,f=0;if(o.type&B.SMOOTH_CURVE_TO&&(d=isNaN(t)?0:i-t,f=isNaN(r)?0:a-r),o.type&(B.CURVE_TO|B.SMOOTH_CURVE_TO)?(t=o.relative?i+o.x2:o.x2,r=o.relative?a+o.y2:o.y2):(t=NaN,r=NaN),o.type&B.SMOOTH_QUAD_TO?(n=isNaN(n)?i:2*i-n,s=isNaN(s)?a:2*a-s):o.type&B.QUAD_TO?(n=o.relative?i+o.x1:o.x1,s=o.relative?a+o.y1:o.y2):(n=NaN,s=NaN),o.type&B.LINE_COMMANDS||o.type&B.ARC&&(0===o.rX||0===o.rY||!o.lArcFlag)||o.type&B.CURVE_TO||o.type&B.SMOOTH_CURVE_TO||o.type&B.QUAD_TO||o.type&B.SMOOTH_QUAD_TO){var h=void 0===o.x?0:o.relative?o.x:o.x-i,p=void 0===o.y?0:o.relative?o.y:o.y-a;d=isNaN(n)?void 0===o.x1?d:o.relative?o.x:o.x1-i:n-i,f=isNaN(s)?void 0===o.y1?f:o.relative?o.y:o.y1-a:s-a;var m=void 0===o.x2?0:o.relative?o.x:o.x2-i,g=void 0===o.y2?0:o.relative?o.y:o.y2-a;c(h)<=e&&c(p)<=e&&c(d)<=e&&c(f)<=e&&c(m)<=e&&c(g)<=e&&(l=!0)}return o.type&B.CLOSE_PATH&&c(i-A)<=e&&c(a-u)<=e&&(l=!0),l?[]:o}))},e.MATRIX=s,e.ROTATE=function(e,t,r){void 0===t&&(t=0),void 0===r&&(r=0),a(e,t,r);var n=Math.sin(e),o=Math.cos(e);return s(o,n,-n,o,t-t*o+r*n,r-t*n-r*o)},e.TRANSLATE=function(e,t){return void 0===t&&(t=0),a(e,t),s(1,0,0,1,e,t)},e.SCALE=function(e,t){return void 0===t&&(t=e),a(e,t),s(e,0,0,t,0,0)},e.SKEW_X=function(e){return a(e),s(1,0,Math.atan(e),1,0,0)},e.SKEW_Y=function(e){return a(e),s(1,Math.atan(e),0,1,0,0)},e.X_AXIS_SYMMETRY=function(e){return void 0===e&&(e=0),a(e),s(-1,0,0,1,e,0)},e.Y_AXIS_SYMMETRY=function(e){return void 0===e&&(e=0),a(e),s(1,0,0,-1,0,e)},e.A_TO_C=function(){return o((function(e,t,r){return B.ARC===e.type?function(e,t,r){var n,o,s,a;e.cX||u(e,t,r);for(var A=Math.min(e.phi1,e.phi2),c=Math.max(e.phi1,e.phi2)-A,l=Math.ceil(c/90),h=new Array(l),p=t,m=r,g=0;g<l;g++){var y=f(e.phi1,e.phi2,g/l),v=f(e.phi1,e.phi2,(g+1)/l),w=v-y,b=4/3*Math.tan(w*d/4),j=[Math.cos(y*d)-b*Math.sin(y*d),Math.sin(y*d)+b*Math.cos(y*d)],_=j[0],C=j[1],x=[Math.cos(v*d),Math.sin(v*d)],E=x[0],N=x[1],Q=[E+b*Math.sin(v*d),N-b*Math.cos(v*d)],F=Q[0],U=Q[1];h[g]={relative:e.relative,type:B.CURVE_TO};var S=function(t,r){var n=i([t*e.rX,r*e.rY],e.xRot),o=n[0],s=n[1];return[e.cX+o,e.cY+s]};n=S(_,C),h[g].x1=n[0],h[g].y1=n[1],o=S(F,U),h[g].x2=o[0],h[g].y2=o[1],s=S(E,N),h[g].x=s[0],h[g].y=s[1],e.relative&&(h[g].x1-=p,h[g].y1-=m,h[g].x2-=p,h[g].y2-=m,h[g].x-=p,h[g].y-=m),p=(a=[h[g].x,h[g].y])[0],m=a[1]}return h}(e,e.relative?0:t,e.relative?0:r):e}))},e.ANNOTATE_ARCS=function(){return o((function(e,t,r){return e.relative&&(t=0,r=0),B.ARC===e.type&&u(e,t,r),e}))},e.CLONE=function(){return function(e){var t={};for(var r in e)t[r]=e[r];return t}},e.CALCULATE_BOUNDS=function(){var e=t(),s=n(),i=r(),a=o((function(t,r,n){var o=i(s(e(function(e){var t={};for(var r in e)t[r]=e[r];return t}(t))));function A(e){e>a.maxX&&(a.maxX=e),e<a.minX&&(a.minX=e)}function l(e){e>a.maxY&&(a.maxY=e),e<a.minY&&(a.minY=e)}if(o.type&B.DRAWING_COMMANDS&&(A(r),l(n)),o.type&B.HORIZ_LINE_TO&&A(o.x),o.type&B.VERT_LINE_TO&&l(o.y),o.type&B.LINE_TO&&(A(o.x),l(o.y)),o.type&B.CURVE_TO){A(o.x),l(o.y);for(var d=0,f=p(r,o.x1,o.x2,o.x);d<f.length;d++)0<(L=f[d])&&1>L&&A(m(r,o.x1,o.x2,o.x,L));for(var g=0,y=p(n,o.y1,o.y2,o.y);g<y.length;g++)0<(L=y[g])&&1>L&&l(m(n,o.y1,o.y2,o.y,L))}if(o.type&B.ARC){A(o.x),l(o.y),u(o,r,n);for(var v=o.xRot/180*Math.PI,w=Math.cos(v)*o.rX,b=Math.sin(v)*o.rX,j=-Math.sin(v)*o.rY,_=Math.cos(v)*o.rY,C=o.phi1<o.phi2?[o.phi1,o.phi2]:-180>o.phi2?[o.phi2+360,o.phi1+360]:[o.phi2,o.phi1],x=C[0],E=C[1],N=function(e){var t=e[0],r=e[1],n=180*Math.atan2(r,t)/Math.PI;return n<x?n+360:n},Q=0,F=c(j,-w,0).map(N);Q<F.length;Q++)(L=F[Q])>x&&L<E&&A(h(o.cX,w,j,L));for(var U=0,S=c(_,-b,0).map(N);U<S.length;U++){var L;(L=S[U])>x&&L<E&&l(h(o.cY,b,_,L))}}return t}));return a.minX=1/0,a.maxX=-1/0,a.minY=1/0,a.maxY=-1/0,a}}(l||(l={}));var g,y=function(){function e(){}return e.prototype.round=function(e){return this.transform(l.ROUND(e))},e.prototype.toAbs=function(){return this.transform(l.TO_ABS())},e.prototype.toRel=function(){return this.transform(l.TO_REL())},e.prototype.normalizeHVZ=function(e,t,r){return this.transform(l.NORMALIZE_HVZ(e,t,r))},e.prototype.normalizeST=function(){return this.transform(l.NORMALIZE_ST())},e.prototype.qtToC=function(){return this.transform(l.QT_TO_C())},e.prototype.aToC=function(){return this.transform(l.A_TO_C())},e.prototype.sanitize=function(e){return this.transform(l.SANITIZE(e))},e.prototype.translate=function(e,t){return this.transform(l.TRANSLATE(e,t))},e.prototype.scale=function(e,t){return this.transform(l.SCALE(e,t))},e.prototype.rotate=function(e,t,r){return this.transform(l.ROTATE(e,t,r))},e.prototype.matrix=function(e,t,r,n,o,s){return this.transform(l.MATRIX(e,t,r,n,o,s))},e.prototype.skewX=function(e){return this.transform(l.SKEW_X(e))},e.prototype.skewY=function(e){return this.transform(l.SKEW_Y(e))},e.prototype.xSymmetry=function(e){return this.transform(l.X_AXIS_SYMMETRY(e))},e.prototype.ySymmetry=function(e){return this.transform(l.Y_AXIS_SYMMETRY(e))},e.prototype.annotateArcs=function(){return this.transform(l.ANNOTATE_ARCS())},e}(),v=function(e){return" "===e||"\t"===e||"\r"===e||"\n"===e},w=function(e){return"0".charCodeAt(0)<=e.charCodeAt(0)&&e.charCodeAt(0)<="9".charCodeAt(0)},b=function(e){function t(){var t=e.call(this)||this;return t.curNumber="",t.curCommandType=-1,t.curCommandRelative=!1,t.canParseCommandOrComma=!0,t.curNumberHasExp=!1,t.curNumberHasExpDigits=!1,t.curNumberHasDecimal=!1,t.curArgs=[],t}return o(t,e),t.prototype.finish=function(e){if(void 0===e&&(e=[]),this.parse(" ",e),0!==this.curArgs.length||!this.canParseCommandOrComma)throw new SyntaxError("Unterminated command at the path end.");return e},t.prototype.parse=function(e,t){var r=this;void 0===t&&(t=[]);for(var n=function(e){t.push(e),r.curArgs.length=0,r.canParseCommandOrComma=!0},o=0;o<e.length;o++){var s=e[o],i=!(this.curCommandType!==B.ARC||3!==this.curArgs.length&&4!==this.curArgs.length||1!==this.curNumber.length||"0"!==this.curNumber&&"1"!==this.curNumber),a=w(s)&&("0"===this.curNumber&&"0"===s||i);if(!w(s)||a)if("e"!==s&&"E"!==s)if("-"!==s&&"+"!==s||!this.curNumberHasExp||this.curNumberHasExpDigits)if("."!==s||this.curNumberHasExp||this.curNumberHasDecimal||i){if(this.curNumber&&-1!==this.curCommandType){var A=Number(this.curNumber);if(isNaN(A))throw new SyntaxError("Invalid number ending at "+o);if(this.curCommandType===B.ARC)if(0===this.curArgs.length||1===this.curArgs.length){if(0>A)throw new SyntaxError('Expected positive number, got "'+A+'" at index "'+o+'"')}else if((3===this.curArgs.length||4===this.curArgs.length)&&"0"!==this.curNumber&&"1"!==this.curNumber)throw new SyntaxError('Expected a flag, got "'+this.curNumber+'" at index "'+o+'"');this.curArgs.push(A),this.curArgs.length===j[this.curCommandType]&&(B.HORIZ_LINE_TO===this.curCommandType?n({type:B.HORIZ_LINE_TO,relative:this.curCommandRelative,x:A}):B.VERT_LINE_TO===this.curCommandType?n({type:B.VERT_LINE_TO,relative:this.curCommandRelative,y:A}):this.curCommandType===B.MOVE_TO||this.curCommandType===B.LINE_TO||this.curCommandType===B.SMOOTH_QUAD_TO?(n({type:this.curCommandType,relative:this.curCommandRelative,x:this.curArgs[0],y:this.curArgs[1]}),B.MOVE_TO===this.curCommandType&&(this.curCommandType=B.LINE_TO)):this.curCommandType===B.CURVE_TO?n({type:B.CURVE_TO,relative:this.curCommandRelative,x1:this.curArgs[0],y1:this.curArgs[1],x2:this.curArgs[2],y2:this.curArgs[3],x:this.curArgs[4],y:this.curArgs[5]}):this.curCommandType===B.SMOOTH_CURVE_TO?n({type:B.SMOOTH_CURVE_TO,relative:this.curCommandRelative,x2:this.curArgs[0],y2:this.curArgs[1],x:this.curArgs[2],y:this.curArgs[3]}):this.curCommandType===B.QUAD_TO?n({type:B.QUAD_TO,relative:this.curCommandRelative,x1:this.curArgs[0],y1:this.curArgs[1],x:this.curArgs[2],y:this.curArgs[3]}):this.curCommandType===B.ARC&&n({type:B.ARC,relative:this.curCommandRelative,rX:this.curArgs[0],rY:this.curArgs[1],xRot:this.curArgs[2],lArcFlag:this.curArgs[3],sweepFlag:this.curArgs[4],x:this.curArgs[5],y:this.curArgs[6]})),this.curNumber="",this.curNumberHasExpDigits=!1,this.curNumberHasExp=!1,this.curNumberHasDecimal=!1,this.canParseCommandOrComma=!0}if(!v(s))if(","===s&&this.canParseCommandOrComma)this.canParseCommandOrComma=!1;else if("+"!==s&&"-"!==s&&"."!==s)if(a)this.curNumber=s,this.curNumberHasDecimal=!1;else{if(0!==this.curArgs.length)throw new SyntaxError("Unterminated command at index "+o+".");if(!this.canParseCommandOrComma)throw new SyntaxError('Unexpected character "'+s+'" at index '+o+". Command cannot follow comma");if(this.canParseCommandOrComma=!1,"z"!==s&&"Z"!==s)if("h"===s||"H"===s)this.curCommandType=B.HORIZ_LINE_TO,this.curCommandRelative="h"===s;else if("v"===s||"V"===s)this.curCommandType=B.VERT_LINE_TO,this.curCommandRelative="v"===s;else if("m"===s||"M"===s)this.curCommandType=B.MOVE_TO,this.curCommandRelative="m"===s;else if("l"===s||"L"===s)this.curCommandType=B.LINE_TO,this.curCommandRelative="l"===s;else if("c"===s||"C"===s)this.curCommandType=B.CURVE_TO,this.curCommandRelative="c"===s;else if("s"===s||"S"===s)this.curCommandType=B.SMOOTH_CURVE_TO,this.curCommandRelative="s"===s;else if("q"===s||"Q"===s)this.curCommandType=B.QUAD_TO,this.curCommandRelative="q"===s;else if("t"===s||"T"===s)this.curCommandType=B.SMOOTH_QUAD_TO,this.curCommandRelative="t"===s;else{if("a"!==s&&"A"!==s)throw new SyntaxError('Unexpected character "'+s+'" at index '+o+".");this.curCommandType=B.ARC,this.curCommandRelative="a"===s}else t.push({type:B.CLOSE_PATH}),this.canParseCommandOrComma=!0,this.curCommandType=-1}else this.curNumber=s,this.curNumberHasDecimal="."===s}else this.curNumber+=s,this.curNumberHasDecimal=!0;else this.curNumber+=s;else this.curNumber+=s,this.curNumberHasExp=!0;else this.curNumber+=s,this.curNumberHasExpDigits=this.curNumberHasExp}return t},t.prototype.transform=function(e){return Object.create(this,{parse:{value:function(t,r){void 0===r&&(r=[]);for(var n=0,o=Object.getPrototypeOf(this).parse.call(this,t);n<o.length;n++){var s=o[n],i=e(s);Array.isArray(i)?r.push.apply(r,i):r.push(i)}return r}}})},t}(y),B=function(e){function t(r){var n=e.call(this)||this;return n.commands="string"==typeof r?t.parse(r):r,n}return o(t,e),t.prototype.encode=function(){return t.encode(this.commands)},t.prototype.getBounds=function(){var e=l.CALCULATE_BOUNDS();return this.transform(e),e},t.prototype.transform=function(e){for(var t=[],r=0,n=this.commands;r<n.length;r++){var o=e(n[r]);Array.isArray(o)?t.push.apply(t,o):t.push(o)}return this.commands=t,this},t.encode=function(e){return s(e)},t.parse=function(e){var t=new b,r=[];return t.parse(e,r),t.finish(r),r},t.CLOSE_PATH=1,t.MOVE_TO=2,t.HORIZ_LINE_TO=4,t.VERT_LINE_TO=8,t.LINE_TO=16,t.CURVE_TO=32,t.SMOOTH_CURVE_TO=64,t.QUAD_TO=128,t.SMOOTH_QUAD_TO=256,t.ARC=512,t.LINE_COMMANDS=t.LINE_TO|t.HORIZ_LINE_TO|t.VERT_LINE_TO,t.DRAWING_COMMANDS=t.HORIZ_LINE_TO|t.VERT_LINE_TO|t.LINE_TO|t.CURVE_TO|t.SMOOTH_CURVE_TO|t.QUAD_TO|t.SMOOTH_QUAD_TO|t.ARC,t}(y),j=((g={})[B.MOVE_TO]=2,g[B.LINE_TO]=2,g[B.HORIZ_LINE_TO]=1,g[B.VERT_LINE_TO]=1,g[B.CLOSE_PATH]=0,g[B.QUAD_TO]=4,g[B.SMOOTH_QUAD_TO]=2,g[B.CURVE_TO]=6,g[B.SMOOTH_CURVE_TO]=4,g[B.ARC]=7,g)}},n={};function o(e){var t=n[e];if(void 0!==t)return t.exports;var s=n[e]={exports:{}};return r[e].call(s.exports,s,s.exports,o),s.exports}o.n=function(e){var t=e&&e.__esModule?function(){return e.default}:function(){return e};return o.d(t,{a:t}),t},t=Object.getPrototypeOf?function(e){return Object.getPrototypeOf(e)}:function(e){return e.__proto__},o.t=function(r,n){if(1&n&&(r=this(r)),8&n)return r;if("object"==typeof r&&r){if(4&n&&r.__esModule)return r;if(16&n&&"function"==typeof r.then)return r}var s=Object.create(null);o.r(s);var i={};e=e||[null,t({}),t([]),t(t)];for(var a=2&n&&r;"object"==typeof a&&!~e.indexOf(a);a=t(a))Object.getOwnPropertyNames(a).forEach((function(e){i[e]=function(){return r[e]}}));return i.default=function(){return r},o.d(s,i),s},o.d=function(e,t){for(var r in t)o.o(t,r)&&!o.o(e,r)&&Object.defineProperty(e,r,{enumerable:!0,get:t[r]})},o.o=function(e,t){return Object.prototype.hasOwnProperty.call(e,t)},o.r=function(e){"undefined"!=typeof Symbol&&Symbol.toStringTag&&Object.defineProperty(e,Symbol.toStringTag,{value:"Module"}),Object.defineProperty(e,"__esModule",{value:!0})};var s={};return function(){"use strict";o.r(s);var e=o("./src/worker.js"),t=(o("./src/plugin/jspdf-plugin.js"),o("./src/plugin/pagebreaks.js"),o("./src/plugin/hyperlinks.js"),function e(t,r){var n=new e.Worker(r);return t?n.from(t).save():n});t.Worker=e.default,s.default=t}(),s.default}()}));
-//# sourceMappingURL=html2pdf.bundle.min.js.map
\ No newline at end of file
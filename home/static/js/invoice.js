@@ -0,0 +1,194 @@
+// Hide button in print
+const style = document.createElement("style");
+style.innerHTML = `@media print { #download-pdf-btn, #back-admin-btn { display: none !important; } }`;
+document.head.appendChild(style);
+
+const ROWS_PER_PAGE = 9;
+const ROWS_PER_PAGE_SUBSEQUENT = 14; // More rows on subsequent pages since no details table
+const MAX_TABLE_HEIGHT = 500; // Maximum height in pixels for items table per page
+
+function paginateInvoice() {
+  const pageContainer = document.getElementById("invoice-content");
+  const firstPage = document.getElementById("invoice-page-1");
+  const header = document.getElementById("invoice-header");
+  const table = document.getElementById("invoice-items-table");
+  const signature = document.getElementById("invoice-signature");
+  const footer = document.getElementById("invoice-footer");
+  if (!pageContainer || !firstPage || !table) return;
+
+  const rows = Array.from(table.querySelectorAll("tbody tr"));
+  if (rows.length === 0) return;
+
+  // Calculate actual rows that fit based on row height
+  const tbody = table.querySelector("tbody");
+  const sampleRowHeight = rows[0]?.offsetHeight || 35;
+  const theadHeight = table.querySelector("thead")?.offsetHeight || 40;
+  const availableHeight = MAX_TABLE_HEIGHT - theadHeight;
+  const calculatedRowsPerPage = Math.floor(
+    availableHeight / sampleRowHeight,
+  );
+  const actualRowsPerPageFirst = Math.max(
+    5,
+    Math.min(calculatedRowsPerPage, ROWS_PER_PAGE),
+  );
+  const actualRowsPerPageSubsequent = Math.max(
+    5,
+    Math.min(calculatedRowsPerPage, ROWS_PER_PAGE_SUBSEQUENT),
+  );
+
+  if (rows.length <= actualRowsPerPageFirst) return;
+
+  const thead = table.querySelector("thead");
+  const tfoot = table.querySelector("tfoot");
+  const theadHtml = thead ? thead.outerHTML : "";
+  const tfootHtml = tfoot ? tfoot.outerHTML : "";
+
+  const chunks = [];
+  let index = 0;
+  chunks.push(rows.slice(index, index + actualRowsPerPageFirst));
+  index += actualRowsPerPageFirst;
+  while (index < rows.length) {
+    chunks.push(rows.slice(index, index + actualRowsPerPageSubsequent));
+    index += actualRowsPerPageSubsequent;
+  }
+
+  tbody.innerHTML = "";
+  chunks[0].forEach((row) => tbody.appendChild(row));
+
+  if (chunks.length > 1) {
+    firstPage.classList.add("invoice-page");
+  }
+
+  if (chunks.length > 1 && tfoot) {
+    tfoot.remove();
+  }
+
+  for (let i = 1; i < chunks.length; i++) {
+    const isLast = i === chunks.length - 1;
+    const page = document.createElement("div");
+    page.className = "invoice-a4 invoice-page";
+
+    if (header) {
+      const headerClone = header.cloneNode(true);
+      headerClone.removeAttribute("id");
+      // Remove details table from subsequent pages
+      const detailsTable = headerClone.querySelector(".details-table");
+      if (detailsTable) {
+        detailsTable.remove();
+      }
+      // Also remove the section titles
+      const sectionTitles = headerClone.querySelector(".section-titles");
+      if (sectionTitles) {
+        sectionTitles.remove();
+      }
+      page.appendChild(headerClone);
+    }
+
+    const pageTable = document.createElement("table");
+    pageTable.className = "items-table";
+    pageTable.style.maxHeight = MAX_TABLE_HEIGHT + "px";
+    pageTable.innerHTML = `${theadHtml}<tbody></tbody>${
+      isLast ? tfootHtml : ""
+    }`;
+    const pageTbody = pageTable.querySelector("tbody");
+    chunks[i].forEach((row) => pageTbody.appendChild(row));
+    page.appendChild(pageTable);
+
+    if (signature) {
+      const signatureClone = signature.cloneNode(true);
+      signatureClone.removeAttribute("id");
+      page.appendChild(signatureClone);
+    }
+
+    if (footer) {
+      const footerClone = footer.cloneNode(true);
+      footerClone.removeAttribute("id");
+      page.appendChild(footerClone);
+    }
+
+    pageContainer.appendChild(page);
+  }
+}
+
+if (document.readyState === "loading") {
+  document.addEventListener("DOMContentLoaded", paginateInvoice);
+} else {
+  paginateInvoice();
+}
+
+// Direct PDF download if 'directdownload=true' in URL
+function getQueryParam(param) {
+  const urlParams = new URLSearchParams(window.location.search);
+  return urlParams.get(param);
+}
+
+function triggerDirectDownload() {
+  // Get invoice number for filename
+  let invoiceNo = "";
+  const invoiceNumberElem = document.querySelector(".invoice-number");
+  if (invoiceNumberElem) {
+    invoiceNo = invoiceNumberElem.textContent.trim().replace(/\s+/g, "");
+  }
+  let filename = invoiceNo ? `Invoice_${invoiceNo}.pdf` : "Invoice.pdf";
+  // Hide the buttons before generating PDF
+  const btn = document.getElementById("download-pdf-btn");
+  if (btn) btn.style.display = "none";
+  const backBtn = document.getElementById("back-admin-btn");
+  if (backBtn) backBtn.style.display = "none";
+  // Generate PDF
+  html2pdf()
+    .set({
+      margin: [10, 10, 10, 10],
+      filename: filename,
+      image: { type: "jpeg", quality: 0.85 },
+      html2canvas: { scale: 2, useCORS: true },
+      jsPDF: { unit: "mm", format: "a4", orientation: "portrait", compress: true },
+      pagebreak: { mode: ["css", "legacy"], avoid: ["tr"] },
+    })
+    .from(document.getElementById("invoice-content"))
+    .save()
+    .then(() => {
+      window.close();
+    });
+}
+
+if (getQueryParam("directdownload") === "true") {
+  // Wait for pagination to complete before downloading
+  setTimeout(triggerDirectDownload, 500);
+}
+
+// Download PDF button handler
+document
+  .getElementById("download-pdf-btn")
+  .addEventListener("click", function () {
+    // Get invoice number for filename
+    let invoiceNo = "";
+    const invoiceNumberElem = document.querySelector(".invoice-number");
+    if (invoiceNumberElem) {
+      invoiceNo = invoiceNumberElem.textContent
+        .trim()
+        .replace(/\s+/g, "");
+    }
+    let filename = invoiceNo ? `Invoice_${invoiceNo}.pdf` : "Invoice.pdf";
+    // Hide the button before generating PDF
+    const btn = document.getElementById("download-pdf-btn");
+    btn.style.display = "none";
+    const backBtn = document.getElementById("back-admin-btn");
+    backBtn.style.display = "none";
+    // Generate PDF
+    html2pdf()
+      .set({
+        margin: [10, 10, 10, 10],
+        filename: filename,
+        image: { type: "jpeg", quality: 0.85 },
+        html2canvas: { scale: 2, useCORS: true },
+        jsPDF: { unit: "mm", format: "a4", orientation: "portrait", compress: true },
+        pagebreak: { mode: ["css", "legacy"], avoid: ["tr"] },
+      })
+      .from(document.getElementById("invoice-content"))
+      .save()
+      .then(() => {
+        btn.style.display = "";
+        backBtn.style.display = "";
+      });
+  });
@@ -0,0 +1,44 @@
+// Chained customer -> vehicle select on the invoice form.
+// With a customer chosen, the vehicle dropdown lists that customer's
+// vehicles; typing searches plate numbers, and picking a vehicle that
+// belongs to someone else switches the customer to its owner.
+'use strict';
+{
+  const $ = django.jQuery;
+
+  function initVehicleChain(element) {
+    const $vehicle = $(element);
+    const $customer = $("#" + element.dataset.customerField);
+    let fillingCustomer = false;
+
+    $vehicle.select2({
+      ajax: {
+        data: (params) => ({
+          term: params.term || "",
+          customer: $customer.val() || "",
+        }),
+      },
+    });
+
+    $vehicle.on("select2:select", (event) => {
+      const vehicle = event.params.data;
+      if (!vehicle.customer || $customer.val() === vehicle.customer) return;
+      if (!$customer.find(`option[value="${vehicle.customer}"]`).length) {
+        $customer.append(new Option(vehicle.customer_text, vehicle.customer, false, false));
+      }
+      fillingCustomer = true;
+      $customer.val(vehicle.customer).trigger("change");
+      fillingCustomer = false;
+    });
+
+    $customer.on("change", () => {
+      if (fillingCustomer) return;
+      // A vehicle picked for the previous customer no longer applies
+      $vehicle.val(null).trigger("change");
+    });
+  }
+
+  $(function () {
+    $("select.vehicle-chain").not("[name*=__prefix__]").each((i, element) => initVehicleChain(element));
+  });
+}
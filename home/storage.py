@@ -0,0 +1,105 @@
+import gzip
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional, gzip is always available
+    brotli = None
+
+
+COMPRESSIBLE_EXTENSIONS = (".css", ".js", ".svg", ".html", ".txt", ".json")
+MIN_COMPRESS_SIZE = 256
+
+# ManifestStaticFilesStorage names files "<name>.<12 hex chars>.<ext>"
+HASHED_NAME_RE = re.compile(r"\.[0-9a-f]{12}\.[^./]+$")
+IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+DEFAULT_MAX_AGE = 60 * 60
+
+
+def precompress_file(path):
+    """Write .gz (and .br if Brotli is installed) next to a static file."""
+    if not path.endswith(COMPRESSIBLE_EXTENSIONS):
+        return []
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < MIN_COMPRESS_SIZE:
+        return []
+
+    written = []
+    variants = [(".gz", lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append((".br", lambda d: brotli.compress(d, quality=11)))
+    for suffix, compress in variants:
+        compressed = compress(data)
+        if len(compressed) >= len(data):
+            continue
+        with open(path + suffix, "wb") as f:
+            f.write(compressed)
+        written.append(path + suffix)
+    return written
+
+
+class PrecompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """Hashed static files plus Brotli/gzip variants written at collectstatic."""
+
+    def post_process(self, paths, dry_run=False, **options):
+        hashed_names = set()
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if hashed_name and not isinstance(processed, Exception):
+                hashed_names.add(hashed_name)
+            yield name, hashed_name, processed
+
+        if dry_run:
+            return
+        for hashed_name in sorted(hashed_names):
+            precompress_file(self.path(hashed_name))
+
+
+def accepted_encodings(request):
+    header = request.META.get("HTTP_ACCEPT_ENCODING", "")
+    return {part.split(";")[0].strip().lower() for part in header.split(",")}
+
+
+def serve_precompressed(request, path):
+    """Serve a collected static file, picking the best precompressed variant.
+
+    Fingerprinted names never change content, so they get a one-year
+    immutable Cache-Control; anything else is cached for an hour.
+    """
+    try:
+        full_path = safe_join(settings.STATIC_ROOT, path)
+    except (SuspiciousFileOperation, TypeError):
+        raise Http404("Invalid static path")
+    if not os.path.isfile(full_path):
+        raise Http404("Static file not found")
+
+    content_type, _ = mimetypes.guess_type(full_path)
+    accepted = accepted_encodings(request)
+    serve_path, encoding = full_path, None
+    for candidate, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if candidate in accepted and os.path.isfile(full_path + suffix):
+            serve_path, encoding = full_path + suffix, candidate
+            break
+
+    response = FileResponse(
+        open(serve_path, "rb"),
+        content_type=content_type or "application/octet-stream",
+    )
+    if encoding:
+        response["Content-Encoding"] = encoding
+    patch_vary_headers(response, ("Accept-Encoding",))
+
+    if HASHED_NAME_RE.search(path):
+        response["Cache-Control"] = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+    else:
+        response["Cache-Control"] = f"public, max-age={DEFAULT_MAX_AGE}"
+    return response
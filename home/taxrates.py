@@ -0,0 +1,108 @@
+"""Process-local lookup of effective-dated tax rates.
+
+All TaxRate rows are loaded once into per-category sorted lists, and the
+rate on a date is found with bisect, so pricing any number of items costs
+no queries. Edits bump a generation token in the shared cache; each
+process checks it at most every RATE_CHECK_SECONDS and reloads when it
+has changed.
+"""
+import bisect
+import datetime
+import threading
+import time
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import DateTimeField, ExpressionWrapper, Subquery
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import TaxRate
+from .utils import generation as tokens
+
+GENERATION_KEY = "taxrates:generation"
+RATE_CHECK_SECONDS = 5
+
+_lock = threading.Lock()
+_table = {}
+_generation = None
+_checked_at = 0.0
+
+
+def _load():
+    table = {}
+    for tax_id, effective_from, rate in TaxRate.objects.order_by(
+            "tax_id", "effective_from").values_list("tax_id", "effective_from", "rate"):
+        dates, rates = table.setdefault(tax_id, ([], []))
+        dates.append(effective_from)
+        rates.append(rate)
+    return table
+
+
+def _rate_table():
+    global _table, _generation, _checked_at
+    now = time.monotonic()
+    if _generation is not None and now - _checked_at < RATE_CHECK_SECONDS:
+        return _table
+    with _lock:
+        generation = tokens.current(GENERATION_KEY)
+        if generation != _generation:
+            _table = _load()
+            _generation = generation
+        _checked_at = now
+    return _table
+
+
+def _published():
+    global _generation
+    tokens.bump(GENERATION_KEY)
+    _generation = None
+
+
+def invalidate():
+    """Drop this process's table and, once the edit commits, tell the other processes to reload.
+
+    A bump before the commit would let another process reload the old
+    rows and keep them under the new token.
+    """
+    global _generation
+    _generation = None
+    transaction.on_commit(_published)
+
+
+def _as_date(value):
+    if isinstance(value, datetime.datetime):
+        return timezone.localdate(value) if timezone.is_aware(value) else value.date()
+    return value
+
+
+def rate_for(tax, on):
+    """Rate (a Decimal percentage) of Taxes ``tax`` on ``on`` (a date or datetime).
+
+    Falls back to ``tax.rate`` when no TaxRate row starts on or before that
+    date, and to 0 when there is no tax category at all.
+    """
+    if tax is None:
+        return Decimal(0)
+    dates, rates = _rate_table().get(tax.pk, ((), ()))
+    index = bisect.bisect_right(dates, _as_date(on)) - 1
+    if index < 0:
+        return tax.rate
+    return rates[index]
+
+
+def rate_on(tax_ref, date_expression):
+    """Subquery for the dated rate of ``tax_ref`` (an OuterRef to a Taxes id).
+
+    The SQL counterpart of rate_for(), served by the (tax, effective_from)
+    index; it is NULL where rate_for() would fall back to Taxes.rate.
+    """
+    return Subquery(
+        TaxRate.objects.filter(
+            tax=tax_ref,
+            effective_from__lte=TruncDate(
+                ExpressionWrapper(date_expression, output_field=DateTimeField())),
+        )
+        .order_by("-effective_from")
+        .values("rate")[:1]
+    )
@@ -1,3 +1,5 @@
+from decimal import Decimal, InvalidOperation
+
 from django import template
 
 register = template.Library()
@@ -5,7 +7,8 @@ register = template.Library()
 
 @register.filter
 def mul(value, arg):
+    # Multiply as Decimal so money amounts are not rounded through float
     try:
-        return float(value) * float(arg)
-    except (ValueError, TypeError):
+        return Decimal(str(value)) * Decimal(str(arg))
+    except (ValueError, TypeError, InvalidOperation):
         return ''
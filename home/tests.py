@@ -1,8 +1,23 @@
+import contextvars
+import datetime
+import gzip
+import importlib.util
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
 from decimal import Decimal
-from django.test import TestCase, Client
+from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.db.models import F
+from django.test import LiveServerTestCase, TestCase, TransactionTestCase, Client, override_settings
 from django.urls import reverse
 from django.utils import timezone
-from .models import Customer, Vehicle, Product, Taxes, Invoice, InvoiceItem
+from .models import ApiToken, EInvoiceSubmission, Customer, Vehicle, Product, Taxes, Invoice, InvoiceItem, ColdInvoice
 
 
 class CustomerModelTest(TestCase):
@@ -251,3 +266,1596 @@ class InvoiceFilteringTest(TestCase):
 
     def test_has_services_method(self):
         self.assertTrue(self.invoice.has_services())
+
+
+class StaticAssetsTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.customer = Customer.objects.create(name="Test Customer")
+        self.vehicle = Vehicle.objects.create(
+            customer=self.customer,
+            make="Honda",
+            number="XYZ-789"
+        )
+        self.invoice = Invoice.objects.create(
+            customer=self.customer,
+            vehicle=self.vehicle
+        )
+
+    def test_invoice_page_has_no_inline_assets(self):
+        response = self.client.get(f'/invoice/{self.invoice.pk}/pdf/')
+        html = response.content.decode()
+        self.assertNotIn('<style>', html)
+        self.assertIn('css/invoice.css', html)
+        self.assertIn('js/invoice.js', html)
+
+    def test_bill_report_has_no_inline_assets(self):
+        response = self.client.get('/billreport/')
+        html = response.content.decode()
+        self.assertNotIn('<style>', html)
+        self.assertIn('css/billreport.css', html)
+
+    def test_dynamic_html_brotli(self):
+        import brotli
+        response = self.client.get(
+            f'/invoice/{self.invoice.pk}/pdf/', HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        html = brotli.decompress(response.content).decode()
+        self.assertIn(self.invoice.invoice_no, html)
+
+    def test_pages_with_csrf_token_are_not_brotli(self):
+        User.objects.create_superuser("admin", "admin@example.com", "pw")
+        self.client.login(username="admin", password="pw")
+        response = self.client.get('/admin/home/invoice/add/', HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn(b'csrfmiddlewaretoken', gzip.decompress(response.content))
+
+    def test_dynamic_html_gzip(self):
+        response = self.client.get(
+            f'/invoice/{self.invoice.pk}/pdf/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        html = gzip.decompress(response.content).decode()
+        self.assertIn(self.invoice.invoice_no, html)
+
+    def test_collectstatic_precompresses_and_serves_immutable(self):
+        with tempfile.TemporaryDirectory() as static_root:
+            storages = {
+                'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+                'staticfiles': {'BACKEND': 'home.storage.PrecompressedManifestStaticFilesStorage'},
+            }
+            with override_settings(STATIC_ROOT=static_root, STORAGES=storages):
+                call_command('collectstatic', interactive=False, verbosity=0)
+                from django.contrib.staticfiles.storage import staticfiles_storage
+                hashed = staticfiles_storage.stored_name('css/invoice.css')
+                self.assertNotEqual(hashed, 'css/invoice.css')
+                self.assertTrue(os.path.exists(os.path.join(static_root, hashed + '.br')))
+                self.assertTrue(os.path.exists(os.path.join(static_root, hashed + '.gz')))
+
+                response = self.client.get(
+                    f'/static/{hashed}', HTTP_ACCEPT_ENCODING='gzip, br')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['Content-Encoding'], 'br')
+                self.assertEqual(response['Content-Type'], 'text/css')
+                self.assertIn('immutable', response['Cache-Control'])
+                b''.join(response.streaming_content)
+
+
+class ArchivedPdfTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.override = override_settings(INVOICE_ARCHIVE_ROOT=self.tmp.name)
+        self.override.enable()
+        self.client = Client()
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "pw"))
+        self.customer = Customer.objects.create(name="Test Customer")
+        self.vehicle = Vehicle.objects.create(
+            customer=self.customer,
+            make="Honda",
+            number="XYZ-789"
+        )
+        self.tax = Taxes.objects.create(name="goods", rate=Decimal("17.00"))
+        self.product = Product.objects.create(
+            name="Test Product",
+            price_excl_tax=Decimal("100.00"),
+            category=self.tax
+        )
+        self.invoice = Invoice.objects.create(
+            customer=self.customer,
+            vehicle=self.vehicle
+        )
+        InvoiceItem.objects.create(
+            invoice=self.invoice,
+            product=self.product,
+            qty=1
+        )
+
+    def tearDown(self):
+        self.override.disable()
+        self.tmp.cleanup()
+
+    def test_store_pdf_deduplicates(self):
+        from .archive import archive_path, store_pdf
+        sha1, size = store_pdf(b"%PDF-same")
+        sha2, _ = store_pdf(b"%PDF-same")
+        self.assertEqual(sha1, sha2)
+        self.assertEqual(size, 9)
+        self.assertTrue(os.path.exists(archive_path(sha1)))
+
+    def test_render_is_deterministic(self):
+        from .utils.pdf import render_invoice_pdf
+        first = render_invoice_pdf(self.invoice, invariant=True)
+        second = render_invoice_pdf(self.invoice, invariant=True)
+        self.assertEqual(first, second)
+
+    def test_qr_and_icons_are_cached_across_renders(self):
+        from .utils import pdf_assets
+        from .utils.pdf import render_invoice_pdf
+        pdf_assets.qr_runs.cache_clear()
+        self.invoice.fbr_invoice_no = "FBR-000123"
+        with_qr = render_invoice_pdf(self.invoice, invariant=True)
+        render_invoice_pdf(self.invoice, invariant=True)
+        self.assertEqual(pdf_assets.qr_runs.cache_info().misses, 1)
+        self.assertEqual(pdf_assets.qr_runs.cache_info().hits, 1)
+        self.assertIs(pdf_assets.image_reader("fbr_icon.png"), pdf_assets.image_reader("fbr_icon.png"))
+        self.invoice.fbr_invoice_no = ""
+        self.assertNotEqual(render_invoice_pdf(self.invoice, invariant=True), with_qr)
+
+    def test_compact_and_merged_output_is_smaller(self):
+        from .utils.pdf import render_invoice_pdf, render_invoices_pdf
+        default = render_invoice_pdf(self.invoice, invariant=True, compact=False)
+        compact = render_invoice_pdf(self.invoice, invariant=True, compact=True)
+        self.assertLess(len(compact) * 2, len(default))
+        merged = render_invoices_pdf([self.invoice] * 3, invariant=True, compact=True)
+        self.assertEqual(merged.count(b"/DCTDecode"), 1)
+        self.assertLess(len(merged), len(compact) * 2)
+
+    def test_mark_as_paid_archives(self):
+        from .admin import mark_as_paid, mark_as_unpaid
+        mark_as_paid(None, None, Invoice.objects.filter(pk=self.invoice.pk))
+        bill_types = set(self.invoice.archived_pdfs.values_list("bill_type", flat=True))
+        self.assertEqual(bill_types, {"complete", "goods"})
+
+        mark_as_unpaid(None, None, Invoice.objects.filter(status="paid"))
+        self.assertFalse(self.invoice.archived_pdfs.exists())
+
+    def test_archived_pdf_view(self):
+        self.assertEqual(Client().get(f'/invoice/{self.invoice.pk}/archive/').status_code, 302)
+        response = self.client.get(f'/invoice/{self.invoice.pk}/archive/')
+        self.assertEqual(response.status_code, 404)
+
+        Invoice.objects.filter(pk=self.invoice.pk).update(status="paid")
+        response = self.client.get(f'/invoice/{self.invoice.pk}/archive/goods/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+        record = self.invoice.archived_pdfs.get(bill_type="goods")
+        self.assertEqual(response['ETag'], f'"{record.sha256}"')
+
+    def test_archives_are_dropped_when_the_invoice_changes(self):
+        from .admin import mark_as_paid
+        from .einvoice import _record
+        paid = Invoice.objects.filter(pk=self.invoice.pk)
+        mark_as_paid(None, None, paid)
+        self.assertTrue(self.invoice.archived_pdfs.exists())
+        InvoiceItem.objects.create(invoice=self.invoice, product=self.product, qty=2)
+        self.assertFalse(self.invoice.archived_pdfs.exists())
+
+        response = self.client.get(f'/invoice/{self.invoice.pk}/archive/')
+        etag = response['ETag']
+        self.assertEqual(self.client.get(
+            f'/invoice/{self.invoice.pk}/archive/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        submission = EInvoiceSubmission.objects.get(invoice=self.invoice, authority="fbr")
+        payload = {"idempotency_key": submission.idempotency_key, "invoice_no": self.invoice.invoice_no}
+        _record("fbr", [(submission.pk, payload)], ("ok", {
+            submission.idempotency_key: {"invoice_number": "FBR-1"}}), timezone.now(),
+            {"submitted": 0, "failed": 0, "retrying": 0})
+        self.assertFalse(self.invoice.archived_pdfs.exists())
+        response = self.client.get(f'/invoice/{self.invoice.pk}/archive/')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_backfill_command(self):
+        Invoice.objects.filter(pk=self.invoice.pk).update(status="paid")
+        call_command('archive_invoices', workers=1, verbosity=0, stdout=io.StringIO())
+        self.assertEqual(self.invoice.archived_pdfs.count(), 2)
+
+
+class PaisaReportTest(TestCase):
+    def setUp(self):
+        self.goods_tax = Taxes.objects.create(name="goods", rate=Decimal("17.00"))
+        self.service_tax = Taxes.objects.create(name="service", rate=Decimal("16.00"))
+        prices = ["0.10", "19.99", "333.33", "1234.57", "7.05"]
+        self.products = [
+            Product.objects.create(
+                name=f"Product {i}",
+                price_excl_tax=Decimal(price),
+                category=self.goods_tax if i % 2 else self.service_tax
+            )
+            for i, price in enumerate(prices)
+        ]
+        for c in range(3):
+            customer = Customer.objects.create(name=f"Customer {c}")
+            vehicle = Vehicle.objects.create(customer=customer, make="Honda", number=f"LEA-{c}")
+            for month in (1, 2):
+                invoice = Invoice.objects.create(
+                    customer=customer,
+                    vehicle=vehicle,
+                    date=timezone.make_aware(timezone.datetime(2025, month, 15))
+                )
+                for i, product in enumerate(self.products):
+                    InvoiceItem.objects.create(
+                        invoice=invoice, product=product, qty=(c + i) % 4 + 1)
+
+    def decimal_totals(self, key):
+        totals = {}
+        for item in InvoiceItem.objects.select_related("invoice"):
+            group = totals.setdefault(key(item), [Decimal("0")] * 3)
+            group[0] += item.price_excl_tax * item.qty
+            group[1] += item.tax_amount
+            group[2] += item.price_incl_tax
+        return totals
+
+    def test_paisa_round_trip(self):
+        from .reports import from_paisa, to_paisa
+        self.assertEqual(to_paisa(Decimal("1234.57")), 123457)
+        self.assertEqual(from_paisa(123457), Decimal("1234.57"))
+
+    def test_totals_by_customer_match_decimal(self):
+        from .reports import item_totals
+        expected = self.decimal_totals(lambda item: item.invoice.customer_id)
+        rows = item_totals(by=("customer",))
+        self.assertEqual(len(rows), 3)
+        for row in rows:
+            self.assertEqual(
+                [row["total_excl_tax"], row["total_tax"], row["total_incl_tax"]],
+                expected[row["customer"]])
+
+    def test_totals_by_month_and_category_match_decimal(self):
+        from .reports import item_totals
+        expected = self.decimal_totals(
+            lambda item: (timezone.localtime(item.invoice.date).month, item.category_id))
+        rows = item_totals(by=("month", "category"))
+        self.assertEqual(len(rows), 4)
+        for row in rows:
+            key = (row["month"].month, row["category"])
+            self.assertEqual(
+                [row["total_excl_tax"], row["total_tax"], row["total_incl_tax"]],
+                expected[key])
+        self.assertEqual(sum(row["items"] for row in rows), 30)
+
+    def test_invoice_totals_match_kernel(self):
+        from .reports import item_totals
+        grand = item_totals(by=())[0]
+        self.assertEqual(
+            grand["total_incl_tax"],
+            sum(inv.total_incl_tax for inv in Invoice.objects.all()))
+
+    def test_mul_filter_keeps_decimal(self):
+        from .templatetags.custom_filters import mul
+        self.assertEqual(mul(Decimal("0.10"), 3), Decimal("0.30"))
+        self.assertEqual(mul("abc", 3), "")
+
+
+class CustomerStatementTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.as_of = timezone.localdate()
+        self.customer = Customer.objects.create(name="Fleet Customer")
+        self.vehicle = Vehicle.objects.create(
+            customer=self.customer,
+            make="Honda",
+            number="XYZ-789"
+        )
+        for age, status, total in [
+            (0, "unpaid", "100.00"),
+            (30, "partial", "200.00"),
+            (31, "unpaid", "300.00"),
+            (75, "unpaid", "400.00"),
+            (120, "unpaid", "500.00"),
+            (10, "paid", "999.00"),
+        ]:
+            invoice = Invoice.objects.create(
+                customer=self.customer,
+                vehicle=self.vehicle,
+                date=timezone.now() - timezone.timedelta(days=age),
+                status=status
+            )
+            Invoice.objects.filter(pk=invoice.pk).update(total_incl_tax=Decimal(total))
+
+    def test_balances_single_grouped_query(self):
+        from .statements import customer_balances
+        # One grouped query over Invoice plus the customer name lookup
+        with self.assertNumQueries(2):
+            rows = customer_balances(as_of=self.as_of)
+        self.assertEqual(len(rows), 1)
+        row = rows[0]
+        self.assertEqual(row["invoices"], 6)
+        self.assertEqual(row["paid"], Decimal("999.00"))
+        self.assertEqual(row["partial"], Decimal("200.00"))
+        self.assertEqual(row["outstanding"], Decimal("1500.00"))
+        self.assertEqual(row["age_0_30"], Decimal("300.00"))
+        self.assertEqual(row["age_31_60"], Decimal("300.00"))
+        self.assertEqual(row["age_61_90"], Decimal("400.00"))
+        self.assertEqual(row["age_90_plus"], Decimal("500.00"))
+
+    def test_statement_view_drill_down(self):
+        self.assertEqual(self.client.get('/statement/').status_code, 302)
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "pw"))
+        response = self.client.get('/statement/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.context['open_invoices'])
+        self.assertEqual(response.context['totals']['outstanding'], Decimal("1500.00"))
+
+        response = self.client.get(f'/statement/?customer={self.customer.pk}')
+        open_invoices = response.context['open_invoices']
+        self.assertEqual(len(open_invoices), 5)
+        self.assertEqual(open_invoices[0]['age_days'], 120)
+
+
+class AdminExportTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.client.force_login(User.objects.create_superuser("admin", "a@example.com", "pw"))
+        self.customer = Customer.objects.create(name="Test Customer")
+        self.vehicle = Vehicle.objects.create(
+            customer=self.customer,
+            make="Honda",
+            number="XYZ-789"
+        )
+        self.tax = Taxes.objects.create(name="goods", rate=Decimal("17.00"))
+        self.product = Product.objects.create(
+            name="Test Product",
+            price_excl_tax=Decimal("100.00"),
+            category=self.tax
+        )
+        self.invoice = Invoice.objects.create(
+            customer=self.customer,
+            vehicle=self.vehicle
+        )
+        for qty in (1, 2):
+            InvoiceItem.objects.create(
+                invoice=self.invoice,
+                product=self.product,
+                qty=qty
+            )
+
+    def run_action(self, action):
+        return self.client.post('/admin/home/invoice/', {
+            'action': action,
+            '_selected_action': [self.invoice.pk],
+        })
+
+    def test_text_that_looks_like_a_formula_is_quoted(self):
+        Customer.objects.filter(pk=self.customer.pk).update(name='=HYPERLINK("http://x","y")')
+        response = self.run_action('export_invoices_csv')
+        line = b''.join(response.streaming_content).decode().splitlines()[1]
+        self.assertIn('"\'=HYPERLINK(""http://x"",""y"")"', line)
+
+    def test_invoice_csv_streams(self):
+        response = self.run_action('export_invoices_csv')
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(',')[0], 'Invoice No')
+        self.assertEqual(len(lines), 2)
+        self.assertIn(self.invoice.invoice_no, lines[1])
+        self.assertIn('351.00', lines[1])
+
+    def test_item_csv_streams(self):
+        response = self.run_action('export_items_csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[2].endswith('234.00'))
+
+    @unittest.skipUnless(importlib.util.find_spec('openpyxl'), 'openpyxl not installed')
+    def test_item_xlsx(self):
+        from openpyxl import load_workbook
+        response = self.run_action('export_items_xlsx')
+        workbook = load_workbook(io.BytesIO(b''.join(response.streaming_content)))
+        rows = list(workbook.active.values)
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1][0], self.invoice.invoice_no)
+
+
+class ColdStorageTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.customer = Customer.objects.create(name="Test Customer")
+        self.vehicle = Vehicle.objects.create(
+            customer=self.customer,
+            make="Honda",
+            number="XYZ-789"
+        )
+        self.tax = Taxes.objects.create(name="goods", rate=Decimal("17.00"))
+        self.product = Product.objects.create(
+            name="Test Product",
+            price_excl_tax=Decimal("100.00"),
+            category=self.tax
+        )
+        self.old = Invoice.objects.create(
+            customer=self.customer,
+            vehicle=self.vehicle,
+            date=timezone.make_aware(timezone.datetime(2023, 3, 10)),
+            status="paid"
+        )
+        InvoiceItem.objects.create(invoice=self.old, product=self.product, qty=2)
+        self.recent = Invoice.objects.create(
+            customer=self.customer,
+            vehicle=self.vehicle
+        )
+
+    def archive(self):
+        from .coldstore import archive_invoices
+        return archive_invoices(timezone.localdate() - timezone.timedelta(days=365), batch_size=1)
+
+    def test_archive_moves_closed_invoices(self):
+        self.assertEqual(self.archive(), 1)
+        self.assertFalse(Invoice.objects.filter(pk=self.old.pk).exists())
+        self.assertFalse(InvoiceItem.objects.filter(invoice_id=self.old.pk).exists())
+        cold = ColdInvoice.objects.get(pk=self.old.pk)
+        self.assertEqual(cold.invoice_no, self.old.invoice_no)
+        self.assertEqual(cold.total_incl_tax, Decimal("234.00"))
+        self.assertEqual(cold.items.count(), 1)
+
+    def test_numbering_continues_from_cold_storage(self):
+        Invoice.objects.filter(pk=self.recent.pk).update(
+            status="paid", date=self.old.date)
+        self.archive()
+        self.assertFalse(Invoice.objects.exists())
+        invoice = Invoice.objects.create(customer=self.customer, vehicle=self.vehicle)
+        self.assertEqual(invoice.invoice_no, "MFES00003")
+
+    def test_bill_report_reads_cold_only_with_date_filter(self):
+        self.archive()
+        response = self.client.get('/billreport/')
+        self.assertEqual(len(response.context['invoices']), 1)
+        response = self.client.get('/billreport/?date_from=2023-01-01')
+        self.assertEqual(len(response.context['invoices']), 2)
+        self.assertEqual(response.context['grand_total'], Decimal("234.00"))
+
+    def test_restore(self):
+        from .coldstore import restore_invoices
+        self.archive()
+        self.assertEqual(restore_invoices(ColdInvoice.objects.all()), 1)
+        restored = Invoice.objects.get(pk=self.old.pk)
+        self.assertEqual(restored.invoice_no, self.old.invoice_no)
+        self.assertEqual(restored.items.get().price_incl_tax, Decimal("234.00"))
+        self.assertFalse(ColdInvoice.objects.exists())
+
+    def test_restore_rewrites_unsent_outbox_rows(self):
+        from .coldstore import restore_invoices
+        Invoice.objects.filter(pk=self.old.pk).update(fbr_invoice_no="FBR-000001")
+        EInvoiceSubmission.objects.filter(invoice=self.old, authority="fbr").update(status="submitted")
+        self.assertEqual(self.archive(), 1)
+        self.assertFalse(EInvoiceSubmission.objects.exists())
+        restore_invoices(ColdInvoice.objects.all())
+        self.assertEqual(list(EInvoiceSubmission.objects.values_list("invoice_id", "authority", "status")),
+                         [(self.old.pk, "pra", "pending")])
+
+    def test_sent_rows_keep_invoice_hot(self):
+        EInvoiceSubmission.objects.filter(invoice=self.old, authority="pra").update(attempts=1)
+        self.assertEqual(self.archive(), 0)
+        EInvoiceSubmission.objects.filter(invoice=self.old, authority="pra").update(status="failed")
+        self.assertEqual(self.archive(), 0)
+
+    def test_admin_points_to_archived_invoices(self):
+        self.archive()
+        self.client.force_login(User.objects.create_superuser("admin", "a@example.com", "pw"))
+        response = self.client.get('/admin/home/invoice/?date__year=2023', follow=True)
+        messages_text = [str(m) for m in response.context['messages']]
+        self.assertTrue(any('1 archived invoices' in m for m in messages_text))
+        response = self.client.get('/admin/home/coldinvoice/?date__year=2023')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, self.old.invoice_no)
+
+
+class ReplicaRouterTest(TestCase):
+    def setUp(self):
+        from .db_router import ReplicaRouter
+        self.router = ReplicaRouter()
+        patcher = mock.patch('home.db_router.replica_available', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads_use_primary_by_default(self):
+        self.assertEqual(self.router.db_for_read(Invoice), 'default')
+
+    def test_replica_views_read_from_replica(self):
+        from .db_router import use_replica
+        read = use_replica(lambda: self.router.db_for_read(Invoice))
+        # A fresh context: writes made by earlier tests pin this thread
+        self.assertEqual(contextvars.Context().run(read), 'replica')
+        self.assertEqual(self.router.db_for_write(Invoice), 'default')
+
+    def test_write_pins_rest_of_request(self):
+        from .db_router import PrimaryPinMiddleware, use_replica, PIN_COOKIE
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+
+        @use_replica
+        def view(request):
+            before = self.router.db_for_read(Invoice)
+            self.router.db_for_write(Invoice)
+            return HttpResponse(f"{before},{self.router.db_for_read(Invoice)}")
+
+        response = PrimaryPinMiddleware(view)(RequestFactory().post('/'))
+        self.assertEqual(response.content, b"replica,default")
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+        @use_replica
+        def read_view(request):
+            return HttpResponse(self.router.db_for_read(Invoice))
+
+        request = RequestFactory().get('/')
+        request.COOKIES[PIN_COOKIE] = "1"
+        self.assertEqual(PrimaryPinMiddleware(read_view)(request).content, b"default")
+        response = PrimaryPinMiddleware(read_view)(RequestFactory().get('/'))
+        self.assertEqual(response.content, b"replica")
+
+    def test_session_writes_do_not_pin(self):
+        from django.contrib.sessions.models import Session
+        from .db_router import use_replica
+
+        @use_replica
+        def view():
+            self.router.db_for_write(Session)
+            return self.router.db_for_read(Invoice)
+        self.assertEqual(contextvars.Context().run(view), 'replica')
+
+
+class RefreshReplicaTest(TransactionTestCase):
+    # The SQLite backup API waits on open write transactions, so this test
+    # cannot run inside TestCase's wrapping transaction.
+    def test_refresh_replica_snapshot(self):
+        import sqlite3
+        customer = Customer.objects.create(name="Snapshot Customer")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'replica.sqlite3')
+            with override_settings(REPLICA_SQLITE_PATH=path):
+                call_command('refresh_replica', stdout=io.StringIO())
+            with sqlite3.connect(path) as snapshot:
+                names = snapshot.execute('SELECT name FROM home_customer').fetchall()
+            snapshot.close()
+        self.assertEqual(names, [(customer.name,)])
+
+    def test_stale_snapshot_falls_back_to_primary(self):
+        from django.conf import settings
+        from .db_router import replica_available
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'replica.sqlite3')
+            with override_settings(REPLICA_SQLITE_PATH=path, REPLICA_MAX_AGE_SECONDS=60), \
+                    mock.patch.dict(settings.DATABASES, replica={"NAME": path}):
+                self.assertFalse(replica_available())
+                call_command('refresh_replica', stdout=io.StringIO())
+                self.assertTrue(replica_available())
+                an_hour_ago = time.time() - 3600
+                os.utime(path, (an_hour_ago, an_hour_ago))
+                self.assertFalse(replica_available())
+            self.assertFalse(replica_available())
+
+
+class StartupImportTest(TestCase):
+    def test_lazy_callable_imports_on_first_call(self):
+        from .utils.lazy import LazyCallable
+        dumps = LazyCallable("json.dumps")
+        self.assertEqual(dumps([1]), "[1]")
+
+    def test_no_heavy_modules_at_startup(self):
+        out = io.StringIO()
+        call_command('profile_startup', top=3, check=True, stdout=out)
+        self.assertIn("No heavy modules imported at startup.", out.getvalue())
+
+
+class FragmentCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.customer = Customer.objects.create(name="Test Customer")
+        self.vehicle = Vehicle.objects.create(
+            customer=self.customer,
+            make="Honda",
+            number="XYZ-789"
+        )
+        self.tax = Taxes.objects.create(name="goods", rate=Decimal("17.00"))
+        self.product = Product.objects.create(
+            name="Test Product",
+            price_excl_tax=Decimal("100.00"),
+            category=self.tax
+        )
+        self.invoices = []
+        for _ in range(3):
+            invoice = Invoice.objects.create(
+                customer=self.customer,
+                vehicle=self.vehicle
+            )
+            InvoiceItem.objects.create(invoice=invoice, product=self.product, qty=1)
+            self.invoices.append(invoice)
+
+    def test_report_rows_render_flags(self):
+        response = self.client.get('/billreport/')
+        html = response.content.decode()
+        for invoice in self.invoices:
+            self.assertIn(f"F-{invoice.invoice_no}", html)
+        self.assertNotIn("P-MFES", html)
+
+    def test_cached_rows_skip_item_queries(self):
+        self.client.get('/billreport/')
+        # Only the invoice list itself; every row comes from the cache
+        with self.assertNumQueries(1):
+            self.client.get('/billreport/')
+
+    def test_edit_invalidates_only_that_row(self):
+        from .fragments import fragment_key, generation
+        self.client.get('/billreport/')
+        edited, untouched = self.invoices[0], self.invoices[1]
+        old_key = fragment_key("billreport_row", edited)
+        InvoiceItem.objects.create(invoice=edited, product=self.product, qty=2)
+        edited.refresh_from_db()
+        self.assertNotEqual(fragment_key("billreport_row", edited), old_key)
+        self.assertIsNotNone(cache.get(fragment_key("billreport_row", untouched)))
+
+        gen = generation()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tax.name = "Goods"
+            self.tax.save()
+            self.assertEqual(generation(), gen)
+        self.assertNotEqual(generation(), gen)
+
+    def test_reference_edit_invalidates_only_its_invoices(self):
+        from .fragments import generation
+        other = Vehicle.objects.create(customer=self.customer, make="Suzuki", number="ABC-1")
+        elsewhere = Invoice.objects.create(customer=self.customer, vehicle=other)
+        self.client.get('/billreport/')
+        gen, version = generation(), elsewhere.version
+        with self.captureOnCommitCallbacks(execute=True):
+            self.vehicle.number = "NEW-1"
+            self.vehicle.save()
+            self.customer.name = "Renamed"
+            self.customer.save()
+        self.assertEqual(generation(), gen)
+        elsewhere.refresh_from_db()
+        self.assertEqual(elsewhere.version, version)
+        self.assertIn("NEW-1", self.client.get('/billreport/').content.decode())
+
+        shown = Invoice.objects.get(pk=self.invoices[0].pk).version
+        self.product.name = "Renamed Product"
+        self.product.save()
+        self.assertEqual(generation(), gen)
+        self.assertEqual(Invoice.objects.get(pk=self.invoices[0].pk).version, shown + 1)
+        elsewhere.refresh_from_db()
+        self.assertEqual(elsewhere.version, version)
+
+    def test_version_bumps_on_changes(self):
+        invoice = self.invoices[0]
+        version = invoice.version
+        invoice.save()
+        self.assertEqual(invoice.version, version + 1)
+        from .admin import mark_as_paid
+        with tempfile.TemporaryDirectory() as tmp, override_settings(INVOICE_ARCHIVE_ROOT=tmp):
+            mark_as_paid(None, None, Invoice.objects.filter(pk=invoice.pk))
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.version, version + 2)
+
+
+@unittest.skipUnless(importlib.util.find_spec("jinja2"), "Jinja2 is not installed")
+class Jinja2TemplatesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer = Customer.objects.create(
+            name="O'Brien & Sons <Pvt>", address="12 Mall Rd", ntn="NTN-9")
+        self.vehicle = Vehicle.objects.create(customer=self.customer, make="Honda", number="XYZ-789")
+        goods = Taxes.objects.create(name="goods", rate=Decimal("17.00"))
+        service = Taxes.objects.create(name="service", rate=Decimal("16.00"))
+        self.invoice = Invoice.objects.create(customer=self.customer, vehicle=self.vehicle)
+        for name, price, category in (("Oil <5W-30>", "1234.50", goods), ("Tuning", "800.00", service)):
+            product = Product.objects.create(name=name, price_excl_tax=Decimal(price), category=category)
+            InvoiceItem.objects.create(invoice=self.invoice, product=product, qty=3)
+        self.empty = Invoice.objects.create(customer=self.customer, vehicle=self.vehicle)
+
+    def assertSameOutput(self, template_name, context):
+        from django.template.loader import render_to_string
+        cache.clear()
+        django_html = render_to_string(template_name, context, using="django")
+        self.assertEqual(render_to_string(template_name, context, using="jinja2"), django_html)
+
+    def test_invoice_output_is_identical(self):
+        from .views import invoice_context
+        for invoice in (self.invoice, self.empty):
+            for special_case in (None, "goods", "services"):
+                with self.subTest(invoice=invoice.pk, special_case=special_case):
+                    self.assertSameOutput("index.html", invoice_context(invoice, special_case))
+
+    def test_bill_report_output_is_identical(self):
+        from .fragments import report_rows
+        invoices = list(Invoice.objects.select_related("customer", "vehicle"))
+        self.assertSameOutput("billreport.html", {
+            "rows": report_rows(invoices),
+            "grand_total": sum(inv.total_incl_tax for inv in invoices),
+            "single_customer_name": self.customer.name,
+            "current_date": timezone.now(),
+        })
+        self.assertSameOutput("billreport.html", {"rows": [], "grand_total": 0, "current_date": timezone.now()})
+
+    def test_views_use_configured_engine(self):
+        with override_settings(INVOICE_TEMPLATE_ENGINE="jinja2"):
+            response = Client().get(f"/invoice/{self.invoice.pk}/pdf/")
+        self.assertEqual(response.templates, [])  # Django-engine renders are recorded here
+        self.assertContains(response, "O&#x27;Brien &amp; Sons &lt;Pvt&gt;")
+
+
+class AuthCacheTest(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import Group, Permission
+        caches["shared"].clear()
+        self.group = Group.objects.create(name="Billing")
+        self.group.permissions.add(Permission.objects.get(codename="view_invoice"))
+        self.user = User.objects.create_user("clerk", password="pw", is_staff=True)
+        self.user.groups.add(self.group)
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def test_admin_navigation_skips_session_and_user_queries(self):
+        self.client.get("/admin/")
+        # Only the "recent actions" panel; session, user and permissions are cached
+        with self.assertNumQueries(1):
+            response = self.client.get("/admin/")
+        self.assertContains(response, "/admin/home/invoice/")
+
+    def test_password_hash_is_not_cached(self):
+        from .auth_backends import user_key
+        self.client.get("/admin/")
+        values, _session_hash, _usable = caches["shared"].get(user_key(self.user.pk))
+        self.assertNotIn(self.user.password, values)
+        self.user.set_password("new")
+        self.user.save()
+        # The old session hash no longer matches
+        self.assertEqual(self.client.get("/admin/").status_code, 302)
+
+    def test_permission_change_is_seen_on_next_request(self):
+        self.client.get("/admin/")
+        self.group.permissions.clear()
+        self.assertNotContains(self.client.get("/admin/"), "/admin/home/invoice/")
+
+    def test_deactivated_user_is_logged_out(self):
+        self.client.get("/admin/")
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get("/admin/").status_code, 302)
+
+
+class RepricingTest(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(name="Test Customer")
+        self.vehicle = Vehicle.objects.create(customer=self.customer, make="Honda", number="XYZ-789")
+        self.goods = Taxes.objects.create(name="goods", rate=Decimal("17.00"))
+        self.service = Taxes.objects.create(name="service", rate=Decimal("16.00"))
+        self.oil = Product.objects.create(name="Oil", price_excl_tax=Decimal("33.33"), category=self.goods)
+        self.tuning = Product.objects.create(name="Tuning", price_excl_tax=Decimal("800.00"), category=self.service)
+        self.unpaid = Invoice.objects.create(customer=self.customer, vehicle=self.vehicle)
+        self.paid = Invoice.objects.create(customer=self.customer, vehicle=self.vehicle)
+        for invoice in (self.unpaid, self.paid):
+            InvoiceItem.objects.create(invoice=invoice, product=self.oil, qty=7)
+            InvoiceItem.objects.create(invoice=invoice, product=self.tuning, qty=1)
+        Invoice.objects.filter(pk=self.paid.pk).update(status="paid")
+
+    def expected_item(self, product, qty):
+        # What saving the item today would store
+        invoice = Invoice.objects.create(customer=self.customer, vehicle=self.vehicle)
+        item = InvoiceItem.objects.create(invoice=invoice, product=product, qty=qty)
+        item.refresh_from_db()
+        invoice.delete()
+        return item
+
+    def test_fresh_items_are_not_stale(self):
+        from .repricing import stale_items
+        self.assertFalse(stale_items().exists())
+
+    def test_price_and_rate_changes_match_save(self):
+        from .repricing import impact, reprice, stale_items
+        self.oil.price_excl_tax = Decimal("41.67")
+        self.oil.save()
+        self.service.rate = Decimal("16.50")
+        self.service.save()
+        version = Invoice.objects.get(pk=self.unpaid.pk).version
+
+        report = impact(stale_items())
+        self.assertEqual([row["invoice_id"] for row in report], [self.unpaid.pk])
+        self.assertEqual(report[0]["items"], 2)
+        self.assertEqual(reprice(stale_items()), (2, 1))
+
+        for product, qty in ((self.oil, 7), (self.tuning, 1)):
+            expected = self.expected_item(product, qty)
+            item = self.unpaid.items.get(product=product)
+            self.assertEqual(
+                (item.price_excl_tax, item.category_id, item.tax_amount, item.price_incl_tax),
+                (expected.price_excl_tax, expected.category_id, expected.tax_amount, expected.price_incl_tax),
+            )
+        invoice = Invoice.objects.get(pk=self.unpaid.pk)
+        self.assertEqual(invoice.total_incl_tax, report[0]["new_total"])
+        self.assertEqual(invoice.version, version + 1)
+        totals = (invoice.total_excl_tax, invoice.total_tax, invoice.total_incl_tax)
+        invoice.update_totals()
+        self.assertEqual((invoice.total_excl_tax, invoice.total_tax, invoice.total_incl_tax), totals)
+
+        # Paid invoices keep the prices they were billed at
+        self.assertEqual(self.paid.items.get(product=self.oil).price_excl_tax, Decimal("33.33"))
+        self.assertFalse(stale_items().exists())
+
+    def test_scoped_to_selected_products(self):
+        from .repricing import stale_items
+        Product.objects.filter(pk__in=[self.oil.pk, self.tuning.pk]).update(price_excl_tax=Decimal("1.00"))
+        self.assertEqual(stale_items(products=[self.oil]).count(), 1)
+        self.assertEqual(stale_items(taxes=[self.service]).count(), 1)
+
+    def test_command_dry_run_changes_nothing(self):
+        Product.objects.filter(pk=self.oil.pk).update(price_excl_tax=Decimal("40.00"))
+        out = io.StringIO()
+        call_command("reprice_invoices", "--dry-run", stdout=out)
+        self.assertIn("1 items on 1 invoices would change by +54.63 PKR in total", out.getvalue())
+        self.assertEqual(self.unpaid.items.get(product=self.oil).price_excl_tax, Decimal("33.33"))
+        call_command("reprice_invoices", stdout=out)
+        self.assertEqual(self.unpaid.items.get(product=self.oil).price_excl_tax, Decimal("40.00"))
+
+
+class TaxRateTest(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(name="Test Customer")
+        self.vehicle = Vehicle.objects.create(customer=self.customer, make="Honda", number="XYZ-789")
+        self.goods = Taxes.objects.create(name="goods", rate=Decimal("17.00"))
+        self.product = Product.objects.create(name="Oil", price_excl_tax=Decimal("100.00"), category=self.goods)
+        self.old = Invoice.objects.create(
+            customer=self.customer, vehicle=self.vehicle, date=timezone.now() - timezone.timedelta(days=30))
+        InvoiceItem.objects.create(invoice=self.old, product=self.product, qty=1)
+
+    def new_item(self, date):
+        invoice = Invoice.objects.create(customer=self.customer, vehicle=self.vehicle, date=date)
+        return InvoiceItem.objects.create(invoice=invoice, product=self.product, qty=1)
+
+    def test_rate_change_keeps_history(self):
+        from .models import TaxRate
+        self.goods.rate = Decimal("18.00")
+        self.goods.save()
+        self.assertEqual(
+            list(self.goods.rates.values_list("rate", flat=True)), [Decimal("17.00"), Decimal("18.00")])
+        self.assertEqual(self.new_item(timezone.now()).tax_amount, Decimal("18.00"))
+        self.assertEqual(self.new_item(self.old.date).tax_amount, Decimal("17.00"))
+        self.assertEqual(self.old.items.get().tax_rate, Decimal("17.00"))
+        self.assertEqual(TaxRate.objects.count(), 2)
+
+    def test_other_processes_are_told_after_commit(self):
+        from .taxrates import GENERATION_KEY
+        from .utils.generation import current
+        before = current(GENERATION_KEY)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.goods.rate = Decimal("18.00")
+            self.goods.save()
+            self.assertEqual(current(GENERATION_KEY), before)
+        self.assertNotEqual(current(GENERATION_KEY), before)
+
+    def test_lookups_need_no_queries(self):
+        from .models import TaxRate
+        from .taxrates import rate_for
+        TaxRate.objects.create(tax=self.goods, rate=Decimal("16.00"), effective_from=datetime.date(2020, 1, 1))
+        TaxRate.objects.create(tax=self.goods, rate=Decimal("18.00"), effective_from=datetime.date(2024, 7, 1))
+        rate_for(self.goods, datetime.date(2024, 1, 1))
+        with self.assertNumQueries(0):
+            self.assertEqual(rate_for(self.goods, datetime.date(2019, 12, 31)), Decimal("17.00"))
+            self.assertEqual(rate_for(self.goods, datetime.date(2024, 6, 30)), Decimal("16.00"))
+            self.assertEqual(rate_for(self.goods, datetime.date(2024, 7, 1)), Decimal("18.00"))
+            self.assertEqual(rate_for(None, datetime.date(2024, 7, 1)), Decimal(0))
+
+    def test_repricing_uses_rate_on_invoice_date(self):
+        from .models import TaxRate
+        from .repricing import reprice, stale_items
+        today = timezone.localdate()
+        TaxRate.objects.create(tax=self.goods, rate=Decimal("17.00"), effective_from=datetime.date(2000, 1, 1))
+        TaxRate.objects.create(tax=self.goods, rate=Decimal("18.00"), effective_from=today)
+        current = self.new_item(timezone.now())
+        self.assertFalse(stale_items().exists())
+        # A correction to last month's rate reaches only last month's invoice
+        TaxRate.objects.filter(effective_from=datetime.date(2000, 1, 1)).update(rate=Decimal("16.00"))
+        self.assertEqual(reprice(stale_items()), (1, 1))
+        self.assertEqual(self.old.items.get().tax_amount, Decimal("16.00"))
+        current.refresh_from_db()
+        self.assertEqual(current.tax_amount, Decimal("18.00"))
+
+
+class GeneratedAmountsTest(TestCase):
+    def setUp(self):
+        customer = Customer.objects.create(name="Test Customer")
+        vehicle = Vehicle.objects.create(customer=customer, make="Honda", number="XYZ-789")
+        self.tax = Taxes.objects.create(name="goods", rate=Decimal("17.00"))
+        self.product = Product.objects.create(name="Oil", price_excl_tax=Decimal("100.00"), category=self.tax)
+        self.invoice = Invoice.objects.create(customer=customer, vehicle=vehicle)
+
+    def test_set_based_writes_stay_consistent(self):
+        items = [InvoiceItem(invoice=self.invoice, product=self.product, qty=qty) for qty in (1, 2, 3)]
+        for item in items:
+            item.apply_pricing()
+        InvoiceItem.objects.bulk_create(items)
+        self.assertEqual(
+            sorted(self.invoice.items.values_list("tax_amount", "price_incl_tax")),
+            [(Decimal("17.00"), Decimal("117.00")), (Decimal("34.00"), Decimal("234.00")),
+             (Decimal("51.00"), Decimal("351.00"))],
+        )
+        self.invoice.items.update(qty=F("qty") * 2, tax_rate=Decimal("16.50"))
+        self.invoice.update_totals()
+        self.assertEqual(self.invoice.total_excl_tax, Decimal("1200.00"))
+        self.assertEqual(self.invoice.total_tax, Decimal("198.00"))
+        self.assertEqual(self.invoice.total_incl_tax, Decimal("1398.00"))
+
+    def test_save_refreshes_amounts(self):
+        item = InvoiceItem.objects.create(invoice=self.invoice, product=self.product, qty=1)
+        item.qty = 4
+        item.save()
+        self.assertEqual((item.tax_amount, item.price_incl_tax), (Decimal("68.00"), Decimal("468.00")))
+
+    def test_half_paisa_lines_total_the_same_everywhere(self):
+        from .views import invoice_context
+        self.tax.rate = Decimal("18.00")
+        self.tax.save()
+        for cents in range(1, 400):
+            self.product.price_excl_tax = Decimal(cents) / 100
+            InvoiceItem.objects.create(invoice=self.invoice, product=self.product, qty=1)
+        # 0.25 at 18% is 0.045 tax: stored rounded half away from zero
+        item = self.invoice.items.get(price_excl_tax=Decimal("0.25"))
+        self.assertEqual((item.tax_amount, item.price_incl_tax), (Decimal("0.05"), Decimal("0.30")))
+        self.invoice.update_totals()
+        context = invoice_context(Invoice.objects.get(pk=self.invoice.pk))
+        self.assertEqual(context["total_tax"], self.invoice.total_tax)
+        self.assertEqual(context["grand_total"], self.invoice.total_incl_tax)
+
+
+class InvoiceConcurrencyTest(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(name="Test Customer")
+        self.vehicle = Vehicle.objects.create(customer=self.customer, make="Honda", number="XYZ-789")
+        tax = Taxes.objects.create(name="goods", rate=Decimal("17.00"))
+        self.product = Product.objects.create(name="Oil", price_excl_tax=Decimal("100.00"), category=tax)
+        self.invoice = Invoice.objects.create(customer=self.customer, vehicle=self.vehicle)
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "pw")
+        self.client = Client()
+        self.client.force_login(self.user)
+        self.url = reverse("admin:home_invoice_change", args=[self.invoice.pk])
+
+    def post_with_new_item(self, seen_version):
+        local = timezone.localtime(self.invoice.date)
+        return self.client.post(self.url, {
+            "customer": self.customer.pk,
+            "vehicle": self.vehicle.pk,
+            "date_0": local.strftime("%Y-%m-%d"),
+            "date_1": local.strftime("%H:%M:%S"),
+            "seen_version": seen_version,
+            "items-TOTAL_FORMS": 1,
+            "items-INITIAL_FORMS": 0,
+            "items-MIN_NUM_FORMS": 0,
+            "items-MAX_NUM_FORMS": 1000,
+            "items-0-product": self.product.pk,
+            "items-0-qty": 2,
+            "items-0-price_excl_tax": "100.00",
+        }, follow=True)
+
+    def test_current_version_saves(self):
+        response = self.post_with_new_item(self.invoice.version)
+        self.assertEqual(response.status_code, 200)
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.total_incl_tax, Decimal("234.00"))
+
+    def test_stale_version_is_rejected_cleanly(self):
+        seen = self.invoice.version
+        # Someone else adds an item after the form was opened
+        InvoiceItem.objects.create(invoice=self.invoice, product=self.product, qty=1)
+        response = self.post_with_new_item(seen)
+        self.assertRedirects(response, self.url)
+        self.assertContains(response, "was changed by someone else")
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.items.count(), 1)
+        self.assertEqual(self.invoice.total_incl_tax, Decimal("117.00"))
+
+    def test_claim_version_is_compare_and_swap(self):
+        from .models import StaleInvoiceError
+        version = self.invoice.version
+        self.invoice.claim_version(version)
+        with self.assertRaises(StaleInvoiceError):
+            self.invoice.claim_version(version)
+
+
+class ProductLookupTest(TestCase):
+    def setUp(self):
+        tax = Taxes.objects.create(name="goods", rate=Decimal("17.00"))
+        names = ["Oil Filter", "Oil Pump", "Air Filter", "Brake Pads", "Engine Oil 5W-30"]
+        names += [f"Spare Part {i:04d}" for i in range(300)]
+        Product.objects.bulk_create(
+            [Product(name=name, price_excl_tax=Decimal("10.00"), category=tax) for name in names])
+        from .product_index import invalidate
+        invalidate()
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "pw")
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def lookup(self, term):
+        response = self.client.get("/products/lookup/", {"term": term})
+        return [row["text"] for row in response.json()["results"]]
+
+    def test_prefix_then_trigram_matches(self):
+        self.assertEqual(self.lookup("oil"), ["Oil Filter", "Oil Pump"] + self.lookup("oil")[2:])
+        self.assertIn("Engine Oil 5W-30", self.lookup("oil"))
+        self.assertEqual(self.lookup("brak pad")[0], "Brake Pads")
+        self.assertEqual(self.lookup(""), [])
+
+    def test_index_follows_product_edits(self):
+        self.lookup("oil")
+        product = Product.objects.get(name="Oil Pump")
+        product.name = "Water Pump"
+        product.save()
+        self.assertNotIn("Oil Pump", self.lookup("oil"))
+        self.assertEqual(self.lookup("water"), ["Water Pump"])
+        with self.assertNumQueries(0):  # session, user and products all come from caches
+            self.lookup("water")
+
+    def test_other_processes_are_told_after_commit(self):
+        from .product_index import GENERATION_KEY
+        from .utils.generation import current
+        before = current(GENERATION_KEY)
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(name="Oil Pump").get().save()
+            self.assertEqual(current(GENERATION_KEY), before)
+        self.assertNotEqual(current(GENERATION_KEY), before)
+
+    def test_add_page_does_not_list_catalogue(self):
+        html = self.client.get(reverse("admin:home_invoice_add")).content.decode()
+        self.assertIn("/products/lookup/", html)
+        self.assertNotIn("Spare Part 0299", html)
+
+    def test_lookup_requires_staff(self):
+        self.assertEqual(Client().get("/products/lookup/", {"term": "oil"}).status_code, 302)
+
+
+class VehicleLookupTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.ali = Customer.objects.create(name="Ali")
+        self.sara = Customer.objects.create(name="Sara")
+        self.corolla = Vehicle.objects.create(customer=self.ali, make="Toyota", number="LEA-1001")
+        self.civic = Vehicle.objects.create(customer=self.ali, make="Honda", number="LEB-2002")
+        self.swift = Vehicle.objects.create(customer=self.sara, make="Suzuki", number="LEA-1234")
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "pw")
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def lookup(self, **params):
+        return self.client.get("/vehicles/lookup/", params).json()["results"]
+
+    def test_customer_vehicles_are_cached(self):
+        results = self.lookup(customer=self.ali.pk)
+        self.assertEqual([r["text"] for r in results], ["Toyota (LEA-1001)", "Honda (LEB-2002)"])
+        with self.assertNumQueries(0):
+            self.lookup(customer=self.ali.pk)
+        Vehicle.objects.create(customer=self.ali, make="Kia", number="LEC-3003")
+        self.assertEqual(len(self.lookup(customer=self.ali.pk)), 3)
+
+    def test_plate_lookup_returns_owner(self):
+        results = self.lookup(term="lea 1")
+        self.assertEqual([(r["text"], r["customer_text"]) for r in results],
+                         [("Toyota (LEA-1001)", "Ali"), ("Suzuki (LEA-1234)", "Sara")])
+        # The plate search ignores the customer already chosen
+        self.assertEqual(len(self.lookup(term="LEA-1", customer=self.ali.pk)), 2)
+        self.assertEqual(self.lookup(), [])
+
+    def test_invoice_form_narrows_vehicles(self):
+        html = self.client.get(reverse("admin:home_invoice_add")).content.decode()
+        self.assertIn("js/vehicle_chain.js", html)
+        self.assertIn("/vehicles/lookup/", html)
+        self.assertNotIn("LEB-2002", html)
+
+    def test_vehicle_must_belong_to_customer(self):
+        from .admin import InvoiceAdminForm
+        form = InvoiceAdminForm(data={
+            "customer": self.ali.pk, "vehicle": self.swift.pk,
+            "date_0": "2025-01-01", "date_1": "10:00:00",
+        })
+        self.assertFalse(form.is_valid())
+        self.assertIn("vehicle", form.errors)
+
+
+class ApiTest(TestCase):
+    def setUp(self):
+        self.tax = Taxes.objects.create(name="Goods", rate=Decimal("18.00"))
+        self.oil = Product.objects.create(name="Oil", price_excl_tax=Decimal("100.00"), category=self.tax)
+        self.filter = Product.objects.create(name="Filter", price_excl_tax=Decimal("50.00"), category=self.tax)
+        self.ali = Customer.objects.create(name="Ali")
+        self.car = Vehicle.objects.create(customer=self.ali, make="Toyota", number="LEA-1")
+        self.user = User.objects.create_superuser("pos", "pos@example.com", "pw")
+        _token, key = ApiToken.issue(self.user, "POS 1")
+        self.auth = {"HTTP_AUTHORIZATION": f"Token {key}"}
+
+    def post_invoices(self, invoices):
+        return self.client.post("/api/v1/invoices/", {"invoices": invoices},
+                                content_type="application/json", **self.auth)
+
+    def test_requires_token_and_permission(self):
+        self.assertEqual(self.client.get("/api/v1/customers/").status_code, 401)
+        self.assertEqual(self.client.get("/api/v1/customers/", HTTP_AUTHORIZATION="Token nope").status_code, 401)
+        clerk = User.objects.create_user("clerk")
+        _token, key = ApiToken.issue(clerk, "clerk")
+        response = self.client.get("/api/v1/customers/", HTTP_AUTHORIZATION=f"Bearer {key}")
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.client.delete("/api/v1/customers/", **self.auth).status_code, 405)
+
+    def test_cursor_pagination_and_projection(self):
+        for i in range(4):
+            Customer.objects.create(name=f"C{i}")
+        names, url = [], "/api/v1/customers/?limit=2&fields=name"
+        while url:
+            page = self.client.get(url, **self.auth).json()
+            self.assertTrue(all(set(row) == {"id", "name"} for row in page["results"]))
+            names += [row["name"] for row in page["results"]]
+            url = page["next"]
+        self.assertEqual(names, ["Ali", "C0", "C1", "C2", "C3"])
+        response = self.client.get("/api/v1/customers/?fields=password", **self.auth)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get("/api/v1/customers/?cursor=zz", **self.auth).status_code, 400)
+
+    def test_bulk_create_with_nested_items(self):
+        response = self.post_invoices([
+            {"customer": self.ali.pk, "vehicle": self.car.pk, "date": "2025-03-01",
+             "items": [{"product": self.oil.pk, "qty": 2}, {"product": self.filter.pk}]},
+            {"customer": self.ali.pk, "vehicle": self.car.pk, "status": "paid",
+             "items": [{"product": self.filter.pk, "qty": 1, "description": "Cabin"}]},
+        ])
+        self.assertEqual(response.status_code, 201)
+        first, second = response.json()["results"]
+        self.assertEqual(first["invoice_no"], "MFES00001")
+        self.assertEqual(second["invoice_no"], "MFES00002")
+        self.assertEqual(Decimal(first["total_excl_tax"]), Decimal("250.00"))
+        self.assertEqual(Decimal(first["total_incl_tax"]), Decimal("295.00"))
+        self.assertEqual([item["qty"] for item in first["items"]], [2, 1])
+        self.assertEqual(second["items"][0]["description"], "Cabin")
+        self.assertEqual(Invoice.objects.get(pk=second["id"]).status, "paid")
+
+        detail = self.client.get(
+            f"/api/v1/invoices/{first['id']}/?fields=invoice_no&item_fields=product_name", **self.auth).json()
+        self.assertEqual(detail["invoice_no"], "MFES00001")
+        self.assertEqual(detail["items"], [{"id": i["id"], "product_name": n}
+                                           for i, n in zip(first["items"], ["Oil", "Filter"])])
+        listing = self.client.get("/api/v1/invoices/?status=paid&items=0", **self.auth).json()
+        self.assertEqual([row["id"] for row in listing["results"]], [second["id"]])
+        self.assertNotIn("items", listing["results"][0])
+
+    def test_bulk_create_is_all_or_nothing(self):
+        sara = Customer.objects.create(name="Sara")
+        response = self.post_invoices([
+            {"customer": self.ali.pk, "vehicle": self.car.pk, "items": [{"product": self.oil.pk}]},
+            {"customer": sara.pk, "vehicle": self.car.pk, "items": [{"product": 999}]},
+        ])
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()["errors"]
+        self.assertEqual(set(errors), {"1"})
+        self.assertIn("vehicle", errors["1"])
+        self.assertIn("items", errors["1"])
+        self.assertFalse(Invoice.objects.exists())
+
+    def test_bulk_create_rejects_wrongly_typed_values(self):
+        response = self.post_invoices([
+            {"customer": [self.ali.pk], "vehicle": {"id": self.car.pk}, "status": ["paid"],
+             "items": [{"product": [self.oil.pk]}]},
+            {"customer": True, "vehicle": self.car.pk,
+             "items": [{"product": self.oil.pk, "qty": True}, {"product": self.oil.pk, "description": ["x"]}]},
+        ])
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()["errors"]
+        self.assertEqual(set(errors["0"]), {"customer", "vehicle", "status", "items"})
+        self.assertEqual(errors["1"]["customer"], "Unknown customer.")
+        self.assertEqual(errors["1"]["items"], {"0": {"qty": "Must be a positive integer."},
+                                               "1": {"description": "Must be a string."}})
+        self.assertFalse(Invoice.objects.exists())
+
+
+class EInvoiceTest(TestCase):
+    def setUp(self):
+        from .einvoice_stub import StubAuthority
+        self.stub = StubAuthority(delay=0.05).start()
+        self.addCleanup(self.stub.stop)
+        self.settings_override = override_settings(
+            EINVOICE_AUTHORITIES={
+                "fbr": {"URL": f"{self.stub.url}/fbr/"},
+                "pra": {"URL": f"{self.stub.url}/pra/"},
+            },
+            EINVOICE_BATCH_SIZE=2, EINVOICE_CONCURRENCY=2,
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+        goods = Taxes.objects.create(name="Goods", rate=Decimal("18.00"))
+        service = Taxes.objects.create(name="Service", rate=Decimal("16.00"))
+        self.oil = Product.objects.create(name="Oil", price_excl_tax=Decimal("100.00"), category=goods)
+        self.tuning = Product.objects.create(name="Tuning", price_excl_tax=Decimal("500.00"), category=service)
+        self.customer = Customer.objects.create(name="Ali")
+        self.vehicle = Vehicle.objects.create(customer=self.customer, make="Toyota", number="LEA-1")
+
+    def paid_invoice(self, *products):
+        invoice = Invoice.objects.create(customer=self.customer, vehicle=self.vehicle)
+        for product in products:
+            InvoiceItem.objects.create(invoice=invoice, product=product)
+        invoice.status = "paid"
+        invoice.save()
+        return invoice
+
+    def test_paying_queues_one_row_per_authority(self):
+        unpaid = Invoice.objects.create(customer=self.customer, vehicle=self.vehicle)
+        invoice = self.paid_invoice(self.oil)
+        invoice.save()
+        rows = EInvoiceSubmission.objects.filter(invoice=invoice)
+        self.assertEqual(sorted(rows.values_list("authority", flat=True)), ["fbr", "pra"])
+        self.assertFalse(EInvoiceSubmission.objects.filter(invoice=unpaid).exists())
+
+    def test_unpaying_keeps_leased_rows(self):
+        from .admin import mark_as_unpaid
+        from .einvoice import claim, enqueue
+        invoice = self.paid_invoice(self.oil)
+        [leased] = claim("fbr", 10)
+        key = EInvoiceSubmission.objects.get(pk=leased).idempotency_key
+        mark_as_unpaid(None, None, Invoice.objects.filter(pk=invoice.pk))
+        self.assertEqual(list(invoice.einvoice_submissions.values_list("pk", flat=True)), [leased])
+        enqueue([invoice.pk])
+        self.assertEqual(invoice.einvoice_submissions.get(authority="fbr").idempotency_key, key)
+        self.assertEqual(invoice.einvoice_submissions.count(), 2)
+
+    def test_submits_in_batches_and_writes_numbers_back(self):
+        from .einvoice import submit_due
+        invoices = [self.paid_invoice(self.oil, self.tuning) for _ in range(5)]
+        goods_only = self.paid_invoice(self.oil)
+
+        counts = submit_due()
+        self.assertEqual(counts, {"submitted": 11, "not_required": 1, "retrying": 0, "failed": 0})
+        self.assertEqual(sorted(size for _authority, size in self.stub.requests), [1, 2, 2, 2, 2, 2])
+        self.assertEqual(self.stub.max_in_flight, 2)
+        invoice = Invoice.objects.get(pk=invoices[0].pk)
+        self.assertTrue(invoice.fbr_invoice_no.startswith("FBR-"))
+        self.assertTrue(invoice.pra_invoice_no.startswith("PRA-"))
+        self.assertGreater(invoice.version, invoices[0].version)
+        self.assertEqual(EInvoiceSubmission.objects.get(invoice=goods_only, authority="pra").status, "not_required")
+        self.assertEqual(submit_due()["submitted"], 0)
+
+    def test_failed_batches_back_off_and_keep_their_number(self):
+        from .einvoice import submit_due
+        invoice = self.paid_invoice(self.oil)
+        self.stub.fail_next(1)
+        counts = submit_due(authorities=["fbr"])
+        self.assertEqual(counts["retrying"], 1)
+        row = EInvoiceSubmission.objects.get(invoice=invoice, authority="fbr")
+        self.assertIn("HTTP 503", row.last_error)
+        self.assertGreater(row.next_attempt_at, timezone.now())
+        self.assertEqual(submit_due(authorities=["fbr"])["submitted"], 0)
+
+        # A lost response: the authority already issued a number for this key
+        self.stub.issued[("fbr", row.idempotency_key)] = "FBR-000042"
+        later = row.next_attempt_at + datetime.timedelta(seconds=1)
+        self.assertEqual(submit_due(authorities=["fbr"], now=later)["submitted"], 1)
+        self.assertEqual(Invoice.objects.get(pk=invoice.pk).fbr_invoice_no, "FBR-000042")
+
+    def test_rejected_invoices_fail_and_stay_hot(self):
+        from .coldstore import archive_invoices
+        from .einvoice import submit_due
+        rejected = self.paid_invoice(self.oil)
+        self.stub.reject.add(rejected.invoice_no)
+        with override_settings(EINVOICE_MAX_ATTEMPTS=1):
+            self.stub.fail_next(1)
+            pending = self.paid_invoice(self.tuning)
+            self.assertEqual(submit_due(authorities=["pra"])["failed"], 1)
+        submit_due(authorities=["fbr"])
+        row = EInvoiceSubmission.objects.get(invoice=rejected, authority="fbr")
+        self.assertEqual((row.status, row.last_error), ("failed", "Invalid buyer NTN."))
+
+        EInvoiceSubmission.objects.filter(invoice=pending).update(status="pending")
+        archive_invoices(timezone.localdate() + datetime.timedelta(days=1))
+        self.assertEqual(list(Invoice.objects.order_by("pk").values_list("pk", flat=True)),
+                         [rejected.pk, pending.pk])
+
+
+class InvoiceEmailTest(TestCase):
+    def setUp(self):
+        goods = Taxes.objects.create(name="Goods", rate=Decimal("18.00"))
+        oil = Product.objects.create(name="Oil", price_excl_tax=Decimal("100.00"), category=goods)
+        self.invoices = []
+        for name, email, count in (("Ali", "ali@example.com", 2), ("Sara", "sara@example.com", 1), ("Bilal", "", 1)):
+            customer = Customer.objects.create(name=name, email=email)
+            vehicle = Vehicle.objects.create(customer=customer, make="Toyota", number=f"LE-{name}")
+            for _ in range(count):
+                invoice = Invoice.objects.create(customer=customer, vehicle=vehicle)
+                InvoiceItem.objects.create(invoice=invoice, product=oil)
+                self.invoices.append(invoice)
+
+    @override_settings(EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend")
+    def test_one_message_per_customer_over_one_connection(self):
+        from .mailing import send_invoices
+        with mock.patch("smtplib.SMTP") as smtp:
+            counts = send_invoices(Invoice.objects.all(), workers=1, per_minute=0)
+        self.assertEqual(counts, {"messages": 2, "sent": 3, "failed": 0, "no_address": 1})
+        # One session per worker, not one per message
+        self.assertEqual(smtp.call_count, 1)
+        self.assertEqual(sorted(call.args[1][0] for call in smtp.return_value.sendmail.call_args_list),
+                         ["ali@example.com", "sara@example.com"])
+        smtp.return_value.quit.assert_called_once()
+
+    def test_messages_carry_each_customers_invoices(self):
+        from django.core import mail
+        from .mailing import send_invoices
+        send_invoices(Invoice.objects.all(), workers=1, per_minute=0)
+        by_recipient = {message.to[0]: message for message in mail.outbox}
+        self.assertEqual(sorted(by_recipient), ["ali@example.com", "sara@example.com"])
+        self.assertEqual(len(by_recipient["ali@example.com"].attachments), 2)
+        self.assertIn("2 invoices", by_recipient["ali@example.com"].subject)
+        self.assertEqual(
+            dict(Invoice.objects.values_list("customer__name", "email_status").distinct()),
+            {"Ali": "sent", "Sara": "sent", "Bilal": "no_address"},
+        )
+        self.assertFalse(Invoice.objects.filter(email_status="sent", emailed_at__isnull=True).exists())
+
+    def test_failed_sends_are_recorded(self):
+        from smtplib import SMTPServerDisconnected
+        from django.core.mail.backends.locmem import EmailBackend
+        from .mailing import send_invoices
+        with mock.patch.object(EmailBackend, "send_messages", side_effect=SMTPServerDisconnected("gone")), \
+                self.assertLogs("home.mailing", "WARNING"):
+            counts = send_invoices(Invoice.objects.filter(customer__name="Ali"), workers=2, per_minute=0)
+        self.assertEqual((counts["failed"], counts["sent"]), (2, 0))
+        self.assertEqual(set(Invoice.objects.filter(customer__name="Ali").values_list("email_status", flat=True)),
+                         {"failed"})
+
+    @override_settings(INVOICE_EMAIL_QUEUE_SIZE=1)
+    def test_no_connection_fails_every_message_without_blocking(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from . import mailing
+        with mock.patch.object(mailing, "get_connection", side_effect=ImproperlyConfigured("no backend")), \
+                self.assertLogs("home.mailing", "WARNING"):
+            counts = mailing.send_invoices(Invoice.objects.all(), workers=1, per_minute=0)
+        self.assertEqual((counts["failed"], counts["sent"]), (3, 0))
+
+    @override_settings(INVOICE_EMAIL_ADMIN_LIMIT=2)
+    def test_admin_action_refuses_large_selections(self):
+        from django.core import mail
+        user = User.objects.create_superuser("admin", "admin@example.com", "pw")
+        self.client.force_login(user)
+        response = self.client.post("/admin/home/invoice/", {
+            "action": "email_invoices", "_selected_action": [invoice.pk for invoice in self.invoices]},
+            follow=True)
+        self.assertContains(response, "manage.py email_invoices")
+        self.assertEqual(mail.outbox, [])
+
+    def test_rate_limiter_spaces_sends(self):
+        from .mailing import RateLimiter
+        sleeps = []
+        limiter = RateLimiter(60, clock=lambda: 100.0, sleep=sleeps.append)
+        for _ in range(3):
+            limiter.wait()
+        self.assertEqual(sleeps, [1.0, 2.0])
+
+    def test_command_skips_already_sent(self):
+        from django.core import mail
+        Invoice.objects.filter(customer__name="Ali").update(email_status="sent")
+        out = io.StringIO()
+        call_command("email_invoices", "--rate", "0", stdout=out)
+        self.assertIn("1 invoices sent in 1 messages", out.getvalue())
+        self.assertEqual([message.to for message in mail.outbox], [["sara@example.com"]])
+
+
+@override_settings(MEMORY_PROFILING=True)
+class MemoryProfileTest(TestCase):
+    def setUp(self):
+        from .memprofile import RECENT_KEY
+        caches["shared"].delete(RECENT_KEY)
+        customer = Customer.objects.create(name="Ali")
+        vehicle = Vehicle.objects.create(customer=customer, make="Toyota", number="LEA-1")
+        Invoice.objects.create(customer=customer, vehicle=vehicle)
+        self.staff = User.objects.create_superuser("admin", "admin@example.com", "pw")
+
+    def test_records_peak_retained_and_stages(self):
+        from .memprofile import profile_memory, recent_profiles, stage
+
+        @profile_memory("buffers")
+        def buffers():
+            with stage("temporary"):
+                scratch = bytearray(2_000_000)
+                del scratch
+            with stage("kept"):
+                return bytearray(500_000)
+
+        with self.assertLogs("home.memprofile", "INFO") as logs:
+            kept = buffers()
+        record = recent_profiles()[0]
+        self.assertIn('"name": "buffers"', logs.output[0])
+        self.assertEqual(record["name"], "buffers")
+        self.assertGreaterEqual(record["peak_bytes"], 2_000_000)
+        self.assertGreaterEqual(record["retained_bytes"], 500_000)
+        temporary, kept_stage = record["stages"]
+        self.assertGreaterEqual(temporary["peak_bytes"], 2_000_000)
+        self.assertLess(temporary["retained_bytes"], 100_000)
+        self.assertGreaterEqual(kept_stage["retained_bytes"], 500_000)
+        self.assertTrue(any("home/tests.py" in site["site"] for site in record["top"]))
+        del kept
+
+    def test_streamed_export_is_measured_to_the_last_chunk(self):
+        from .admin import export_invoices_csv
+        from .memprofile import recent_profiles
+        with self.assertLogs("home.memprofile", "INFO"):
+            response = export_invoices_csv(None, None, Invoice.objects.all())
+            self.assertEqual(recent_profiles(), [])
+            b"".join(response.streaming_content)
+        record = recent_profiles()[0]
+        self.assertEqual(record["name"], "home.admin.export_invoices_csv")
+        self.assertEqual([s["label"] for s in record["stages"]], ["stream"])
+
+    def test_report_view_and_staff_page(self):
+        with self.assertLogs("home.memprofile", "INFO"):
+            self.client.get("/billreport/")
+        self.assertEqual(self.client.get("/memory/").status_code, 302)
+        self.client.force_login(self.staff)
+        html = self.client.get("/memory/").content.decode()
+        self.assertIn("home.views.bill_report", html)
+        self.assertIn("load invoices", html)
+
+    @override_settings(MEMORY_PROFILING=False)
+    def test_off_by_default(self):
+        from .memprofile import recent_profiles
+        self.client.get("/billreport/")
+        self.assertEqual(recent_profiles(), [])
+
+
+class RequestProfileTest(TestCase):
+    def setUp(self):
+        customer = Customer.objects.create(name="Ali")
+        vehicle = Vehicle.objects.create(customer=customer, make="Toyota", number="LEA-1")
+        Invoice.objects.create(customer=customer, vehicle=vehicle)
+        self.staff = User.objects.create_superuser("admin", "admin@example.com", "pw")
+
+    def test_staff_request_is_profiled(self):
+        from .models import RequestProfile
+        self.client.force_login(self.staff)
+        response = self.client.get("/billreport/?_profile=1&start=2020-01-01")
+        self.assertEqual(response.status_code, 200)
+        profile = RequestProfile.objects.get(pk=response["X-Profile-Id"])
+        self.assertEqual((profile.method, profile.path, profile.query), ("GET", "/billreport/", "start=2020-01-01"))
+        self.assertEqual(profile.user, self.staff)
+        self.assertGreater(profile.queries, 0)
+        self.assertEqual(profile.size, len(profile.stacks.encode()))
+
+    def test_admin_changelist_does_not_see_the_flag(self):
+        self.client.force_login(self.staff)
+        response = self.client.get("/admin/home/invoice/?_profile=1")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("X-Profile-Id", response)
+
+    def test_off_without_flag_or_for_non_staff(self):
+        from .models import RequestProfile
+        self.client.get("/billreport/?_profile=1")
+        clerk = User.objects.create_user("clerk", password="pw")
+        self.client.force_login(clerk)
+        self.client.get("/billreport/?_profile=1")
+        self.client.force_login(self.staff)
+        self.client.get("/billreport/")
+        self.client.get("/billreport/?_profile=0")
+        self.assertFalse(RequestProfile.objects.exists())
+
+    def test_sampler_and_call_tree(self):
+        from .profiling import Sampler, call_tree, collapse
+
+        def spin():
+            deadline = time.perf_counter() + 0.05
+            while time.perf_counter() < deadline:
+                pass
+
+        with Sampler(threading.get_ident(), 0.001) as sampler:
+            spin()
+        tree = call_tree(collapse(sampler.stacks))
+        self.assertEqual(tree["count"], sum(sampler.stacks.values()))
+        self.assertGreater(tree["count"], 5)
+        self.assertEqual(sum(child["count"] for child in tree["children"]), tree["count"])
+        self.assertIn("spin (home/tests.py", collapse(sampler.stacks))
+
+        tree = call_tree("a;b 30\na;c 1\na 969\nd 1000\n")
+        self.assertEqual(tree["count"], 2000)
+        a = next(child for child in tree["children"] if child["name"] == "a")
+        self.assertEqual((a["name"], a["count"]), ("a", 1000))
+        # c has 1 of 2000 samples, below MIN_NODE_SHARE
+        self.assertEqual([(c["name"], c["count"]) for c in a["children"]], [("b", 30)])
+
+    def test_eviction_keeps_newest_within_limit(self):
+        from .models import RequestProfile
+        from .profiling import evict
+        for index in range(4):
+            RequestProfile.objects.create(
+                method="GET", path=f"/{index}/", status_code=200, duration_ms=1, queries=0,
+                samples=1, interval_ms=1, stacks="main 1\n", size=100)
+        self.assertEqual(evict(limit=250), 2)
+        self.assertEqual(sorted(RequestProfile.objects.values_list("path", flat=True)), ["/2/", "/3/"])
+        self.assertEqual(evict(limit=250), 0)
+
+    def test_admin_shows_flame_graph(self):
+        from .models import RequestProfile
+        profile = RequestProfile.objects.create(
+            method="GET", path="/billreport/", status_code=200, duration_ms=12, queries=3,
+            samples=4, interval_ms=1, stacks="main;bill_report 3\nmain 1\n", size=28)
+        self.client.force_login(self.staff)
+        html = self.client.get(f"/admin/home/requestprofile/{profile.pk}/change/").content.decode()
+        self.assertIn("flex: 0 0 75.000%", html)
+        self.assertIn("bill_report", html)
+        response = self.client.post("/admin/home/requestprofile/", {
+            "action": "download_collapsed_stacks", "_selected_action": [profile.pk]})
+        self.assertEqual(response.content, b"main;bill_report 3\nmain 1\n")
+
+
+class LoadTestTest(LiveServerTestCase):
+    def setUp(self):
+        tax = Taxes.objects.create(name="goods", rate=Decimal("17.00"))
+        customer = Customer.objects.create(name="Ali")
+        vehicle = Vehicle.objects.create(customer=customer, make="Toyota", number="LEA-1")
+        Product.objects.create(name="Oil", price_excl_tax=Decimal("100.00"), category=tax)
+        Invoice.objects.create(customer=customer, vehicle=vehicle)
+        User.objects.create_superuser("clerk", "clerk@example.com", "pw")
+
+    def test_run_saves_invoices_and_reports(self):
+        out = io.StringIO()
+        call_command("load_test", url=self.live_server_url, username="clerk", password="pw",
+                     users="1", duration=1, seed=1, verbosity=2, stdout=out)
+        report = out.getvalue()
+        self.assertIn("p99 ms", report)
+        self.assertIn("invoice save", report)
+        self.assertIn("Peak throughput", report)
+        row = report.splitlines()[1].split()
+        self.assertEqual(row[0], "1")
+        self.assertGreater(int(row[1]), 0)
+        self.assertEqual(row[6:], ["0.0%", "0.0%", "0.0%"])
+        self.assertGreater(Invoice.objects.count(), 1)
+        self.assertTrue(InvoiceItem.objects.exists())
+
+    def test_wrong_password(self):
+        from django.core.management.base import CommandError
+        with self.assertRaisesMessage(CommandError, "answered 200"):
+            call_command("load_test", url=self.live_server_url, username="clerk", password="nope",
+                         users="1", duration=1, stdout=io.StringIO())
+
+    def test_locked_requests_are_retried_then_counted(self):
+        from .loadtest import LOCK_RETRIES, SimulatedUser, load_fixtures
+        user = SimulatedUser(self.live_server_url, "clerk", "pw", load_fixtures())
+        records = []
+        answers = iter([503, 302])
+        with mock.patch("home.loadtest.LOCK_BACKOFF", 0):
+            user.timed("invoice save", lambda: (next(answers), 302), records)
+            user.timed("invoice save", lambda: (503, 302), records)
+        self.assertEqual([record[2:] for record in records], [("ok", 1), ("locked", LOCK_RETRIES)])
+
+    def test_summary_and_saturation(self):
+        from .loadtest import percentile, saturation, summarize
+        self.assertEqual(percentile(list(range(1, 101)), 0.95), 95)
+        self.assertEqual(percentile([], 0.5), 0.0)
+        summary = summarize([("print", 0.1, "ok", 0), ("print", 0.3, "error", 0),
+                             ("print", 0.2, "locked", 3), ("print", 0.4, "ok", 1)], elapsed=2)
+        self.assertEqual((summary["requests"], summary["throughput"], summary["p50"]), (4, 2.0, 0.2))
+        self.assertEqual((summary["error_rate"], summary["locked_rate"], summary["lock_retry_rate"]),
+                         (0.5, 0.25, 0.5))
+        levels = [(1, {"throughput": 10}), (2, {"throughput": 19}), (4, {"throughput": 20})]
+        self.assertEqual(saturation(levels), 2)
+        self.assertIsNone(saturation(levels[:2]))
+
+    def test_database_lock_answers_503(self):
+        from django.contrib.sessions.middleware import SessionMiddleware
+        from django.core.handlers.exception import convert_exception_to_response
+        from django.db import OperationalError
+        from django.test import RequestFactory
+        from .middleware import DatabaseLockedMiddleware
+
+        def handler(message):
+            def save_session(request):
+                raise OperationalError(message)
+
+            # As in the handler's chain: each layer turns its exception into a 500
+            session = SessionMiddleware(lambda request: None)
+            session.process_response = lambda request, response: save_session(request)
+            return DatabaseLockedMiddleware(convert_exception_to_response(session))
+
+        request = RequestFactory().post("/admin/home/invoice/add/")
+        with self.assertLogs("django.request", "ERROR"), self.assertLogs("home.middleware", "WARNING"):
+            response = handler("database is locked")(request)
+        self.assertEqual((response.status_code, response["Retry-After"]), (503, "1"))
+        request = RequestFactory().post("/admin/home/invoice/add/")
+        with self.assertLogs("django.request", "ERROR"):
+            self.assertEqual(handler("no such table")(request).status_code, 500)
@@ -0,0 +1,31 @@
+"""Generation tokens: a cache key whose value changes on every invalidation.
+
+Per-process tables and cache keys built from the current token go stale
+as soon as another process bumps it. Tokens live in the cache named by
+SHARED_CACHE_ALIAS unless a caller passes its own.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+def shared_cache():
+    """The cache every worker process sees."""
+    return caches[settings.SHARED_CACHE_ALIAS]
+
+
+def _new_token():
+    return uuid.uuid4().hex[:12]
+
+
+def current(key, cache=None):
+    """The token stored under ``key``, created on first use."""
+    cache = shared_cache() if cache is None else cache
+    return cache.get_or_set(key, _new_token, None)
+
+
+def bump(key, cache=None):
+    """Replace the token under ``key``, invalidating everything built on the old one."""
+    cache = shared_cache() if cache is None else cache
+    cache.set(key, _new_token(), None)
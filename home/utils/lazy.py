@@ -0,0 +1,21 @@
+from django.utils.module_loading import import_string
+
+
+class LazyCallable:
+    """Stand-in for a function whose module is imported on first call.
+
+    Used for heavy dependencies (ReportLab, NumPy, HTML/PDF engines) so that
+    importing the admin or URLconf does not pull them into every process.
+    """
+
+    def __init__(self, dotted_path):
+        self.dotted_path = dotted_path
+        self._func = None
+
+    def __call__(self, *args, **kwargs):
+        if self._func is None:
+            self._func = import_string(self.dotted_path)
+        return self._func(*args, **kwargs)
+
+    def __repr__(self):
+        return f"<LazyCallable {self.dotted_path}>"
@@ -1,36 +1,54 @@
 # utils/pdf.py
 import io
+from django.conf import settings
 from django.http import HttpResponse
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.platypus import (
-    SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Flowable
+    SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Flowable, PageBreak
 )
 from reportlab.lib.units import cm, mm
 
+from .pdf_assets import draw_qr, image_reader
 
-class BoxPlaceholder(Flowable):
-    """Draw an empty framed box (used as the FBR logo placeholder)."""
 
-    def __init__(self, width, height, stroke=1, dash=None):
+class AuthorityStamp(Flowable):
+    """The authority's icon with the QR code of the number it issued.
+
+    Until the number arrives (see home/einvoice.py) the QR side is left
+    as an empty frame, like the old placeholder.
+    """
+
+    def __init__(self, width, height, icon, number="", compact=False):
         super().__init__()
         self.width = width
         self.height = height
-        self.stroke = stroke
-        self.dash = dash
+        self.icon = icon
+        self.number = number
+        self.compact = compact
 
     def wrap(self, availWidth, availHeight):
         return (self.width, self.height)
 
     def draw(self):
-        if self.dash:
-            self.canv.setDash(self.dash)
-        self.canv.setLineWidth(self.stroke)
-        self.canv.rect(0, 0, self.width, self.height)
+        side = self.height
+        icon = image_reader(self.icon, self.compact)
+        icon_w, icon_h = icon.getSize()
+        scale = min((self.width - side) / icon_w, side / icon_h) * 0.9
+        self.canv.drawImage(
+            icon, ((self.width - side) - icon_w * scale) / 2, (side - icon_h * scale) / 2,
+            icon_w * scale, icon_h * scale, mask=None if self.compact else "auto",
+        )
+        if self.number:
+            draw_qr(self.canv, self.number, self.width - side, 0, side)
+        else:
+            self.canv.setLineWidth(0.5)
+            self.canv.setDash(2, 2)
+            self.canv.rect(self.width - side + 2, 2, side - 4, side - 4)
 
 
-def generate_invoice_pdf(invoice, special_case=""):
+def _build(flowables, invariant, compact):
     buffer = io.BytesIO()
     doc = SimpleDocTemplate(
         buffer,
@@ -39,8 +57,47 @@ def generate_invoice_pdf(invoice, special_case=""):
         rightMargin=18 * mm,
         topMargin=16 * mm,
         bottomMargin=16 * mm,
+        invariant=invariant,
+        # Compact output never depends on the process-wide rl_config default
+        pageCompression=1 if compact else None,
     )
+    doc.build(flowables)
+    return buffer.getvalue()
+
+
+def _compact(compact):
+    return settings.INVOICE_PDF_COMPACT if compact is None else compact
+
+
+def render_invoice_pdf(invoice, special_case="", invariant=False, compact=None):
+    """Build the invoice PDF and return its bytes.
 
+    With ``invariant=True`` ReportLab omits timestamps and random document
+    IDs, so the same invoice always renders to the same bytes. ``compact``
+    (default: the INVOICE_PDF_COMPACT setting) compresses every stream and
+    embeds the icons as small JPEGs.
+    """
+    compact = _compact(compact)
+    return _build(invoice_flowables(invoice, special_case, compact), invariant, compact)
+
+
+def render_invoices_pdf(invoices, special_case="", invariant=False, compact=None):
+    """Several invoices in one PDF, each starting on a new page.
+
+    Fonts and images are written once and shared by every page, so a
+    merged file is much smaller than the separate PDFs put together.
+    """
+    compact = _compact(compact)
+    flowables = []
+    for invoice in invoices:
+        if flowables:
+            flowables.append(PageBreak())
+        flowables += invoice_flowables(invoice, special_case, compact)
+    return _build(flowables, invariant, compact)
+
+
+def invoice_flowables(invoice, special_case="", compact=False):
+    """The platypus story of one invoice."""
     styles = getSampleStyleSheet()
     # --- Custom styles (readable on A4) ---
     title = ParagraphStyle(
@@ -227,7 +284,7 @@ def generate_invoice_pdf(invoice, special_case=""):
             Paragraph(f"{item.price_excl_tax:.2f}", tbl_small_right),
             Paragraph(f"{(item.price_excl_tax * item.qty):.2f}",
                       tbl_small_right),
-            Paragraph(f"{item.category.rate:.2f}%", tbl_small_right) if item.category else Paragraph(
+            Paragraph(f"{item.tax_rate:.2f}%", tbl_small_right) if item.category else Paragraph(
                 "-", tbl_small_right),
             Paragraph(f"{item.tax_amount:.2f}", tbl_small_right),
             Paragraph(f"{item.price_incl_tax:.2f}", tbl_small_right),
@@ -294,19 +351,24 @@ def generate_invoice_pdf(invoice, special_case=""):
     elements.append(sign_tbl)
     elements.append(Spacer(1, 8))
 
-    # ========== FOOTER (disclaimer left, FBR placeholder right) ==========
+    # ========== FOOTER (disclaimer left, authority QR right) ==========
     disclaimer = Paragraph(
         "Customer’s vehicle driven and stored entirely at customer’s own risk at repair firm; theft, damage, or loss is not the firm’s responsibility.",
         tbl_small
     )
+    # Services bills are PRA's; goods and complete bills carry FBR's number
+    if special_case == "P-":
+        authority, icon, issued = "PRA", "pra_icon.png", getattr(invoice, "pra_invoice_no", "")
+    else:
+        authority, icon, issued = "FBR", "fbr_icon.png", getattr(invoice, "fbr_invoice_no", "")
     fbr_box = Table(
-        [[BoxPlaceholder(40*mm, 18*mm)]],
+        [[AuthorityStamp(40*mm, 18*mm, icon, issued, compact)]],
         colWidths=[40*mm],
         style=[("BOX", (0, 0), (-1, -1), 0.8, colors.black)],
         hAlign="RIGHT",
     )
     fbr_num = Paragraph(
-        f"FBR Invoice Number: {getattr(invoice, 'invoice_no', '')}",
+        f"{authority} Invoice Number: {issued or getattr(invoice, 'invoice_no', '')}",
         tbl_small_center,
     )
 
@@ -328,10 +390,11 @@ def generate_invoice_pdf(invoice, special_case=""):
         hAlign="LEFT",
     )
     elements.append(footer)
+    return elements
+
 
-    # Build & return
-    doc.build(elements)
-    buffer.seek(0)
-    response = HttpResponse(buffer, content_type="application/pdf")
+def generate_invoice_pdf(invoice, special_case=""):
+    pdf = render_invoice_pdf(invoice, special_case)
+    response = HttpResponse(pdf, content_type="application/pdf")
     response["Content-Disposition"] = f'attachment; filename="{invoice.invoice_no}.pdf"'
     return response
@@ -1,32 +1,96 @@
-from .models import Invoice
-from django.shortcuts import render
-from django.db.models import Prefetch
+import os
+
+from .models import ColdInvoice, Invoice
+from .archive import BILL_TYPE_PREFIXES, archive_invoice, archive_path
+from .coldstore import date_range_filter
+from .db_router import use_replica
+from .fragments import generation, report_rows
+from .lookups import customer_vehicles, vehicles_by_plate
+from .memprofile import profile_memory, recent_profiles, stage
+from .product_index import product_index
+from .statements import AGING_BUCKETS, customer_balances, customer_open_invoices
+from django.contrib.admin.views.decorators import staff_member_required
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponseNotModified, JsonResponse
+from django.shortcuts import get_object_or_404, render
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 
 # Bill report view: show all invoices in a table
 
 
+@profile_memory()
+@use_replica
 def bill_report(request):
     ids = request.GET.get('ids')
-    qs = Invoice.objects.select_related('customer', 'vehicle').prefetch_related(
-        'items__product', 'items__category')
+    date_from = parse_date(request.GET.get('date_from') or '')
+    date_to = parse_date(request.GET.get('date_to') or '')
+    # Rows come from the fragment cache; items are only read for cache misses
+    qs = Invoice.objects.select_related('customer', 'vehicle')
     if ids:
         id_list = [int(i) for i in ids.split(',') if i.isdigit()]
         qs = qs.filter(id__in=id_list)
-    grand_total = sum(inv.total_incl_tax for inv in qs)
-    customer_ids = set(inv.customer_id for inv in qs)
+    date_filter = date_range_filter(date_from, date_to)
+    with stage("load invoices"):
+        invoices = list(qs.filter(**date_filter))
+        if date_filter and not ids:
+            # Only an explicit date range reaches into cold storage
+            invoices += ColdInvoice.objects.select_related('customer', 'vehicle').filter(**date_filter)
+            invoices.sort(key=lambda inv: inv.id)
+    grand_total = sum(inv.total_incl_tax for inv in invoices)
+    customer_ids = set(inv.customer_id for inv in invoices)
     single_customer_name = None
-    if len(customer_ids) == 1 and qs:
-        single_customer_name = qs[0].customer.name
+    if len(customer_ids) == 1 and invoices:
+        single_customer_name = invoices[0].customer.name
     current_date = timezone.now()
+    with stage("rows"):
+        rows = report_rows(invoices)
     return render(
         request,
         "billreport.html",
         {
-            "invoices": qs,
+            "invoices": invoices,
+            "rows": rows,
             "grand_total": grand_total,
             "single_customer_name": single_customer_name,
             "current_date": current_date,  # <-- Add this line
+        },
+        using=settings.INVOICE_TEMPLATE_ENGINE,
+    )
+
+
+# Customer statement: outstanding balances and receivables aging per customer
+
+
+@staff_member_required
+@profile_memory()
+@use_replica
+def customer_statement(request):
+    as_of = parse_date(request.GET.get('as_of') or '') or timezone.localdate()
+    customer = request.GET.get('customer')
+    customer_id = int(customer) if customer and customer.isdigit() else None
+
+    rows = customer_balances(as_of=as_of, customer_id=customer_id)
+    for row in rows:
+        row["buckets"] = [row[key] for key, *_ in AGING_BUCKETS]
+    totals = {
+        key: sum(row[key] for row in rows)
+        for key in ("paid", "partial", "unpaid", "outstanding")
+    }
+    totals["buckets"] = [sum(row[key] for row in rows) for key, *_ in AGING_BUCKETS]
+
+    open_invoices = None
+    if customer_id is not None:
+        open_invoices = customer_open_invoices(customer_id, as_of=as_of)
+    return render(
+        request,
+        "statement.html",
+        {
+            "rows": rows,
+            "totals": totals,
+            "bucket_labels": [label for _key, label, *_ in AGING_BUCKETS],
+            "open_invoices": open_invoices,
+            "as_of": as_of,
         }
     )
 
@@ -47,7 +111,7 @@ def invoice_pdf_services(request, pk):
     return _render_invoice_html(request, invoice, special_case="services")
 
 
-def _render_invoice_html(request, invoice, special_case=None):
+def invoice_context(invoice, special_case=None):
     # Filter items for each bill type
     filtered_items = []
     for item in invoice.items.all():
@@ -64,11 +128,99 @@ def _render_invoice_html(request, invoice, special_case=None):
     total_tax = sum(item.tax_amount for item in filtered_items)
     grand_total = sum(item.price_incl_tax for item in filtered_items)
 
-    return render(request, "index.html", {
+    return {
         "invoice": invoice,
         "items": filtered_items,
         "subtotal": subtotal,
         "total_tax": total_tax,
         "grand_total": grand_total,
         "special_case": special_case,
+        "fragment_generation": generation(),
+    }
+
+
+def _render_invoice_html(request, invoice, special_case=None):
+    return render(
+        request, "index.html", invoice_context(invoice, special_case),
+        using=settings.INVOICE_TEMPLATE_ENGINE,
+    )
+
+
+@staff_member_required
+def invoice_archived_pdf(request, pk, bill_type="complete"):
+    """Stream the archived PDF of a paid invoice straight from disk.
+
+    FileResponse hands the open file to the server's wsgi.file_wrapper, so
+    the PDF is sent without being read into Python.
+    """
+    if bill_type not in BILL_TYPE_PREFIXES:
+        raise Http404("Unknown bill type")
+    invoice = get_object_or_404(Invoice, pk=pk)
+    record = invoice.archived_pdfs.filter(bill_type=bill_type).first()
+    if record is None and invoice.status == "paid":
+        archive_invoice(invoice)
+        record = invoice.archived_pdfs.filter(bill_type=bill_type).first()
+    if record is None or not os.path.exists(archive_path(record.sha256)):
+        raise Http404("No archived PDF for this invoice")
+
+    # Re-rendered when the invoice changes or its FBR/PRA number arrives,
+    # so browsers revalidate rather than keep it forever
+    etag = f'"{record.sha256}"'
+    if request.headers.get("If-None-Match") == etag:
+        response = HttpResponseNotModified()
+        response["ETag"] = etag
+        return response
+    response = FileResponse(
+        open(archive_path(record.sha256), "rb"),
+        content_type="application/pdf",
+        as_attachment=request.GET.get("directdownload") == "true",
+        filename=f"{BILL_TYPE_PREFIXES[bill_type]}{invoice.invoice_no}.pdf",
+    )
+    response["ETag"] = etag
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+
+# Product lookup for the invoice item inline (select2 JSON format)
+
+PRODUCT_LOOKUP_LIMIT = 20
+
+
+@staff_member_required
+def product_lookup(request):
+    term = request.GET.get("term", "")
+    matches = product_index().search(term, limit=PRODUCT_LOOKUP_LIMIT)
+    return JsonResponse({
+        "results": [{"id": str(pk), "text": name} for pk, name in matches],
+        "pagination": {"more": False},
+    })
+
+
+# Chained customer -> vehicle lookups for the invoice form
+
+
+@staff_member_required
+def vehicle_lookup(request):
+    """Vehicles by plate across all customers; with only a customer, that customer's vehicles."""
+    term = request.GET.get("term", "").strip()
+    customer = request.GET.get("customer", "")
+    customer_id = int(customer) if customer.isdigit() else None
+    if term:
+        # The chosen customer is ignored: a plate can switch the invoice to its owner
+        results = vehicles_by_plate(term)
+    elif customer_id is not None:
+        results = customer_vehicles(customer_id)
+    else:
+        results = []
+    return JsonResponse({"results": results, "pagination": {"more": False}})
+
+
+# Recent memory profiles (see home/memprofile.py)
+
+
+@staff_member_required
+def memory_profiles(request):
+    return render(request, "memory_profiles.html", {
+        "enabled": settings.MEMORY_PROFILING,
+        "profiles": recent_profiles(),
     })